@@ -71,6 +71,9 @@ def create_dynamodb_record(record_path):
         record_data["created_at"] = now_iso
         record_data["updated_at"] = now_iso
         print(f"Timestamps set: {now_iso}")
+        # Version stamp for the Lambdas' config cache. Later edits should bump it, but the
+        # cache also compares updated_at, so an edit that only sets updated_at is picked up too
+        record_data["config_version"] = 1
 
         # Prepare for DynamoDB (handle floats -> Decimal)
         dynamodb_item = replace_floats_with_decimal(record_data)
@@ -0,0 +1,297 @@
+# Batch Runner - WhatsApp
+
+"""
+Scheduled companion of the messaging Lambda for projects in batch mode
+(core/batch_service.py). The messaging handler parks such a conversation in
+'batch_pending' and queues its chat.completions request on BATCH_QUEUE_URL;
+every run of this handler then:
+
+    submit     receives up to BATCH_MAX_REQUESTS queued requests, groups them by
+               OpenAI secret and model, submits one batch per group and records
+               it (dynamodb_service.record_batch). Queue messages are deleted
+               once their batch is recorded; anything else is left to reappear
+    collect    polls every open batch. Once a batch has ended each request is
+               delivered: the conversation is claimed (still waiting on exactly
+               that request), the reply sent through Twilio and stored as the
+               interactive path stores it. Failed requests set the conversation
+               to 'retry'; transient failures also get a reprocess trigger
+
+Superseded requests (the user wrote again and the new trigger answered both)
+fail the claim, and their results are dropped.
+
+Invoked with {"action": "reprocess", "company_id": ..., "project_id": ...,
+"statuses": [...], "limit": ...} it instead sends a reprocess trigger to
+WHATSAPP_QUEUE_URL for every matching conversation (default status 'retry').
+Projects with ai_config.batch_mode 'reprocess' answer those through batches,
+at batch prices and outside the interactive rate limits.
+"""
+
+import datetime
+import json
+import logging
+import os
+
+from . import index
+from .core import batch_service
+from .core import context_window
+from .core import key_pool
+from .core import openai_service
+from .services import dynamodb_service
+from .services import secrets_manager_service
+from .services import sqs_service
+from .services import twilio_service
+from .utils import metrics
+from .utils import retry_policy
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+
+# --- Configuration ---
+BATCH_QUEUE_URL = os.environ.get('BATCH_QUEUE_URL')
+WHATSAPP_QUEUE_URL = os.environ.get('WHATSAPP_QUEUE_URL')
+# Queued requests taken per run (OpenAI allows up to 50,000 per batch)
+BATCH_MAX_REQUESTS = int(os.environ.get('BATCH_MAX_REQUESTS', '1000'))
+# Received requests stay hidden this long while their batch is submitted
+BATCH_RECEIVE_VISIBILITY_SECONDS = int(os.environ.get('BATCH_RECEIVE_VISIBILITY_SECONDS', '300'))
+REPROCESS_DEFAULT_STATUSES = ('retry',)
+
+# deliver_reply outcomes
+DELIVERED = "DELIVERED"
+SUPERSEDED = "SUPERSEDED"
+FAILED = "FAILED"       # request failed for good; the conversation is left in 'retry'
+RETRY = "RETRY"         # request failed transiently; a reprocess trigger was sent
+DB_ERROR = "DB_ERROR"   # the conversation could not be read or updated; the batch stays open
+
+
+def _api_key(secret_ref):
+    """The first API key of an OpenAI secret (batches are tied to the key that created them), or None."""
+    status, secret = secrets_manager_service.get_secret(secret_ref)
+    if status != secrets_manager_service.SECRET_SUCCESS:
+        logger.error(f"Could not fetch OpenAI secret {secret_ref} ({status}).")
+        return None
+    keys = key_pool.api_keys(secret)
+    return keys[0] if keys else None
+
+
+def _send_reprocess_trigger(primary_channel, conversation_id):
+    """Queues a reprocess trigger for a conversation on the messaging queue."""
+    if not WHATSAPP_QUEUE_URL:
+        logger.error("WHATSAPP_QUEUE_URL not set. Cannot send reprocess trigger.")
+        return False
+    ts = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+    status = sqs_service.send_message(WHATSAPP_QUEUE_URL, {
+        'conversation_id': conversation_id,
+        'primary_channel': primary_channel,
+        'reprocess': True
+    }, group_id=conversation_id, deduplication_id=f"{conversation_id}:reprocess:{ts}")
+    return status == sqs_service.SQS_SENT
+
+
+def submit_pending():
+    """Submits the queued batch requests. Returns the number of requests submitted."""
+    if not BATCH_QUEUE_URL:
+        logger.error("BATCH_QUEUE_URL not set. Nothing to submit.")
+        return 0
+    messages = sqs_service.receive_messages(BATCH_QUEUE_URL, BATCH_MAX_REQUESTS, BATCH_RECEIVE_VISIBILITY_SECONDS)
+    if not messages:
+        return 0
+
+    # Every request of a batch must use the same key and model
+    groups = {}
+    for receipt_handle, request in messages:
+        if not all(request.get(field) for field in ('custom_id', 'primary_channel', 'conversation_id', 'api_key_reference', 'body')):
+            logger.error(f"Skipping malformed batch request: {json.dumps(request)[:200]}")
+            continue
+        groups.setdefault((request['api_key_reference'], request['body'].get('model')), []).append((receipt_handle, request))
+
+    submitted = 0
+    for (secret_ref, model), group in groups.items():
+        api_key = _api_key(secret_ref)
+        if not api_key:
+            continue
+        # A conversation queued twice (redelivery) is only submitted once
+        requests = list({request['custom_id']: request for _, request in group}.values())
+        status, result = batch_service.submit(api_key, requests, metadata={'model': str(model)})
+        if status != openai_service.AI_SUCCESS:
+            logger.error(f"Batch submission of {len(requests)} requests ({model}) failed ({status}): {result.get('error_message')}")
+            continue
+        recorded = dynamodb_service.record_batch(result['batch_id'], secret_ref, {
+            request['custom_id']: {'primary_channel': request['primary_channel'], 'conversation_id': request['conversation_id']}
+            for request in requests
+        })
+        if not recorded:
+            # The requests reappear and go into another batch; this one's results would be unclaimed
+            logger.error(f"Batch {result['batch_id']} could not be recorded. Its requests will be submitted again.")
+            continue
+        sqs_service.delete_messages(BATCH_QUEUE_URL, [receipt_handle for receipt_handle, _ in group])
+        submitted += len(requests)
+    return submitted
+
+
+def _fail_request(primary_channel, conversation_id, custom_id, ai_status, payload):
+    """A batch request without a usable result: 'retry', and a reprocess trigger if worth another try."""
+    error_msg = (payload or {}).get('error_message')
+    release_status = dynamodb_service.release_batch_request(primary_channel, conversation_id, custom_id)
+    if release_status == dynamodb_service.BATCH_SUPERSEDED:
+        return SUPERSEDED
+    if release_status != dynamodb_service.DB_SUCCESS:
+        return DB_ERROR
+    metrics.put_metric('batch_reply_failed', 1, metrics.UNIT_COUNT)
+    if ai_status == openai_service.AI_TRANSIENT_ERROR and _send_reprocess_trigger(primary_channel, conversation_id):
+        logger.warning(f"Batch request {custom_id} failed ({error_msg}); {conversation_id} sent for reprocessing.")
+        return RETRY
+    logger.error(f"Batch request {custom_id} failed ({error_msg}); {conversation_id} left in 'retry'.")
+    return FAILED
+
+
+def deliver_reply(primary_channel, conversation_id, custom_id, ai_status, payload):
+    """
+    Delivers one batch result like the messaging handler's Steps 10-13 (send,
+    final update, staging cleanup). Returns DELIVERED, SUPERSEDED, FAILED,
+    RETRY or DB_ERROR.
+    """
+    if ai_status != openai_service.AI_SUCCESS:
+        return _fail_request(primary_channel, conversation_id, custom_id, ai_status, payload)
+
+    claim_status, batch_request = dynamodb_service.claim_batch_reply(primary_channel, conversation_id, custom_id)
+    if claim_status == dynamodb_service.BATCH_SUPERSEDED:
+        metrics.put_metric('batch_reply_superseded', 1, metrics.UNIT_COUNT)
+        return SUPERSEDED
+    if claim_status != dynamodb_service.LOCK_ACQUIRED:
+        return DB_ERROR
+
+    # From here the conversation is locked: every failure hands it back as 'retry'
+    try:
+        db_data = index._hydrate_conversation(primary_channel, conversation_id)
+        if db_data is None:
+            raise Exception(f"Could not read conversation {conversation_id}")
+        channel_config = db_data.get('channel_config', {})
+        sender_num = channel_config.get('company_whatsapp_number')
+        secret_status, twilio_creds = secrets_manager_service.get_secret(channel_config.get('whatsapp_credentials_id'))
+        if secret_status != secrets_manager_service.SECRET_SUCCESS or not sender_num:
+            raise Exception(f"Missing Twilio credentials or sender number ({secret_status})")
+        final_reply_body = index._reply_body(payload.get('response_content'))
+        if not final_reply_body:
+            raise Exception("Could not extract the reply body from the batch result")
+
+        with metrics.timer('twilio_send'):
+            twilio_status, twilio_result = index._send_reply(
+                twilio_creds, primary_channel, sender_num, final_reply_body, db_data.get('rate_limits')
+            )
+        if twilio_status != twilio_service.TWILIO_SUCCESS:
+            raise Exception(f"Twilio send failed ({twilio_status}): {(twilio_result or {}).get('error_message')}")
+
+        user_message_map = {
+            "message_id": batch_request['first_message_sid'],
+            "timestamp": batch_request.get('queued_at') or datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "role": "user",
+            "content": batch_request['combined_body']
+        }
+        assistant_message_map = {
+            "message_id": twilio_result['message_sid'],
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "role": "assistant",
+            "content": final_reply_body if 'message_sids' in twilio_result else twilio_result['body'],
+            "prompt_tokens": payload['prompt_tokens'],
+            "completion_tokens": payload['completion_tokens'],
+            "total_tokens": payload['total_tokens']
+        }
+        if 'message_sids' in twilio_result:
+            assistant_message_map['message_sids'] = twilio_result['message_sids']
+    except Exception as e:
+        logger.exception(f"Could not deliver batch request {custom_id} for {conversation_id}: {e}")
+        if not dynamodb_service.release_lock_for_retry(primary_channel, conversation_id):
+            logger.error(f"FAILED TO RELEASE LOCK for {primary_channel}/{conversation_id} after batch delivery failure!")
+        metrics.put_metric('batch_reply_failed', 1, metrics.UNIT_COUNT)
+        return FAILED
+
+    update_kwargs = {}
+    window = context_window.plan(db_data.get('ai_config', {}), db_data)
+    activated_window = context_window.activation(window, assistant_message_map.get('prompt_tokens'))
+    if activated_window is not None:
+        update_kwargs['context_window'] = activated_window
+
+    update_status, update_error_msg = dynamodb_service.update_conversation_after_reply(
+        primary_channel_pk=primary_channel,
+        conversation_id_sk=conversation_id,
+        user_message_map=user_message_map,
+        assistant_message_map=assistant_message_map,
+        new_status="reply_sent",
+        task_complete=db_data.get('task_complete', 0),
+        hand_off_to_human=db_data.get('hand_off_to_human', False),
+        hand_off_to_human_reason=db_data.get('hand_off_to_human_reason'),
+        **update_kwargs
+    )
+    if update_status != dynamodb_service.DB_SUCCESS:
+        # The reply was sent - don't deliver it again
+        logger.critical(f"CRITICAL: Final DB update failed for {conversation_id} after batch reply {custom_id} was sent! Error: {update_error_msg}. Manual investigation needed.")
+        return DELIVERED
+
+    keys_to_delete_staging = [{'conversation_id': conversation_id, 'message_sid': sid}
+                              for sid in batch_request.get('message_sids') or [batch_request['first_message_sid']]]
+    if not dynamodb_service.cleanup_staging_table(keys_to_delete_staging):
+        logger.warning(f"Cleanup of staging table failed for {conversation_id}. TTL will handle.")
+    metrics.put_metric('batch_reply_delivered', 1, metrics.UNIT_COUNT)
+    logger.info(f"Delivered batch reply {custom_id} for conversation {conversation_id}.")
+    return DELIVERED
+
+
+def collect_results():
+    """Delivers the results of every ended batch. Returns {outcome: count}."""
+    outcomes = {}
+    batch_ids = dynamodb_service.list_open_batches()
+    if batch_ids is None:
+        return outcomes
+    for batch_id in batch_ids:
+        record = dynamodb_service.get_batch_record(batch_id)
+        if not record:
+            logger.error(f"Open batch {batch_id} has no record (expired?). Closing it.")
+            dynamodb_service.close_batch(batch_id)
+            continue
+        api_key = _api_key(record.get('api_key_reference'))
+        if not api_key:
+            continue
+        status, polled = batch_service.poll(api_key, batch_id)
+        if status != openai_service.AI_SUCCESS:
+            logger.error(f"Polling batch {batch_id} failed ({status}): {polled.get('error_message')}")
+            continue
+        if polled['state'] != batch_service.BATCH_ENDED:
+            continue
+
+        batch_outcomes = []
+        for custom_id, target in (record.get('requests') or {}).items():
+            ai_status, payload = polled['results'].get(custom_id) or batch_service.missing_result(polled['status'], custom_id)
+            outcome = deliver_reply(target['primary_channel'], target['conversation_id'], custom_id, ai_status, payload)
+            batch_outcomes.append(outcome)
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        # Requests whose conversation couldn't be read or updated are tried again on the next run
+        if DB_ERROR not in batch_outcomes:
+            dynamodb_service.close_batch(batch_id)
+    return outcomes
+
+
+def reprocess(company_id=None, project_id=None, statuses=REPROCESS_DEFAULT_STATUSES, limit=None):
+    """Sends a reprocess trigger for every matching conversation. Returns the number sent (None on scan error)."""
+    keys = dynamodb_service.scan_conversations_by_status(tuple(statuses), company_id, project_id, limit)
+    if keys is None:
+        return None
+    sent = sum(1 for key in keys if _send_reprocess_trigger(key['primary_channel'], key['conversation_id']))
+    logger.info(f"Sent {sent} of {len(keys)} reprocess triggers (statuses {list(statuses)}, company {company_id}, project {project_id}).")
+    metrics.put_metric('reprocess_triggers_sent', sent, metrics.UNIT_COUNT)
+    return sent
+
+
+@metrics.flush_after_invocation
+@retry_policy.per_invocation
+def handler(event, context):
+    event = event or {}
+    metrics.begin_scope(channel='whatsapp')
+    if event.get('action') == 'reprocess':
+        sent = reprocess(event.get('company_id'), event.get('project_id'),
+                         event.get('statuses') or REPROCESS_DEFAULT_STATUSES, event.get('limit'))
+        return {'reprocess_triggers': sent}
+
+    submitted = submit_pending()
+    outcomes = collect_results()
+    logger.info(f"Batch run finished: {submitted} requests submitted, results {outcomes}.")
+    return {'submitted': submitted, 'delivered': outcomes}
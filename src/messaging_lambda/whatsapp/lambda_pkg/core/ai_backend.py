@@ -0,0 +1,89 @@
+# core/ai_backend.py - Messaging Lambda (WhatsApp)
+"""
+Chooses how a reply is generated. The backend is set per project in
+`ai_config.backend`; projects without one use AI_BACKEND_DEFAULT.
+
+    threads           OpenAI Assistants thread: add message, create run, poll,
+                      list messages (openai_service). OpenAI keeps the history.
+    chat_completions  one chat.completions request built from the history stored
+                      on the conversation item (chat_completions_service)
+
+Every backend takes the same arguments and returns the same (status, payload)
+tuples as openai_service.process_reply_with_ai, so the handler treats them alike.
+"""
+
+import logging
+import os
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from . import openai_service
+from . import chat_completions_service
+from . import context_window
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+
+BACKEND_THREADS = "threads"
+BACKEND_CHAT_COMPLETIONS = "chat_completions"
+
+AI_BACKEND_DEFAULT = os.environ.get('AI_BACKEND_DEFAULT', BACKEND_THREADS)
+
+
+def _threads(thread_id, assistant_id, user_message_content, api_key, history, on_text, window):
+    run_options = context_window.run_options(window) if window else None
+    if on_text is not None:
+        return openai_service.stream_reply_with_ai(thread_id, assistant_id, user_message_content, api_key, on_text,
+                                                   run_options=run_options)
+    return openai_service.process_reply_with_ai(thread_id, assistant_id, user_message_content, api_key,
+                                                run_options=run_options)
+
+
+def _chat_completions(thread_id, assistant_id, user_message_content, api_key, history, on_text, window):
+    additional_instructions = None
+    if window:
+        history = context_window.recent_history(window, history)
+        additional_instructions = context_window.summary_instructions(window)
+    return chat_completions_service.process_reply_with_chat(assistant_id, user_message_content, api_key,
+                                                            history=history, on_text=on_text,
+                                                            additional_instructions=additional_instructions)
+
+
+# name -> (generate function, whether it needs the stored history)
+BACKENDS = {
+    BACKEND_THREADS: (_threads, False),
+    BACKEND_CHAT_COMPLETIONS: (_chat_completions, True),
+}
+
+
+def backend_for(ai_config: Optional[Dict[str, Any]]) -> str:
+    """The backend name for a conversation's ai_config (unknown names fall back to the default)."""
+    name = (ai_config or {}).get('backend') or AI_BACKEND_DEFAULT
+    if name not in BACKENDS:
+        logger.warning(f"Unknown AI backend '{name}', using '{AI_BACKEND_DEFAULT}'.")
+        name = AI_BACKEND_DEFAULT if AI_BACKEND_DEFAULT in BACKENDS else BACKEND_THREADS
+    return name
+
+
+def needs_history(backend: str) -> bool:
+    """True if the backend builds its prompt from the stored conversation history."""
+    return BACKENDS[backend][1]
+
+
+def generate_reply(
+    backend: str,
+    thread_id: Optional[str],
+    assistant_id: str,
+    user_message_content: str,
+    api_key: str,
+    history: Optional[List[Dict[str, Any]]] = None,
+    on_text: Optional[Callable[[str], None]] = None,
+    window: Optional[Dict[str, Any]] = None
+) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """
+    Generates the assistant's reply to user_message_content with the given backend.
+    With on_text, the reply is streamed and on_text(delta) is called as it is generated.
+    window (context_window.plan) limits how much of the history the prompt includes.
+    """
+    generate, _ = BACKENDS[backend]
+    logger.info(f"Generating reply with the '{backend}' backend")
+    return generate(thread_id, assistant_id, user_message_content, api_key, history, on_text, window)
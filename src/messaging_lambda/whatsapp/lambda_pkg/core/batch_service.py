@@ -0,0 +1,260 @@
+# core/batch_service.py - Messaging Lambda (WhatsApp)
+"""
+OpenAI Batch API execution for replies that can wait: requests are collected
+into a JSONL file, submitted as one batch, and their results fetched once the
+batch has ended. Batches cost about half as much per token as interactive
+requests and don't count against the project's per-minute rate limits; they
+finish within BATCH_COMPLETION_WINDOW (usually much sooner).
+
+Projects opt in with `ai_config.batch_mode`:
+
+    off        every reply is generated interactively (default)
+    reprocess  only bulk-reprocessed conversations (batch_runner 'reprocess'
+               triggers) are answered through batches
+    always     every reply of the project - for channels where nobody is
+               waiting on the answer
+
+The Batch API has no Assistants endpoint, so a batch request is the
+chat.completions request the chat_completions backend would send (the
+assistant's model and instructions plus the stored history). Projects on the
+threads backend keep answering interactively.
+
+Everything here talks to OpenAI only; queueing the requests, tracking the
+batches and delivering the replies is batch_runner.py. Returns the same
+(status, payload) tuples as openai_service.process_reply_with_ai.
+"""
+
+import io
+import json
+import logging
+import os
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+import openai
+
+from . import chat_completions_service
+from . import context_window
+from . import key_pool
+from ..utils import metrics
+from .openai_service import (
+    AI_SUCCESS, AI_TRANSIENT_ERROR, AI_NON_TRANSIENT_ERROR, AI_INVALID_INPUT, _api_error_status
+)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+
+BATCH_MODE_OFF = "off"
+BATCH_MODE_REPROCESS = "reprocess"
+BATCH_MODE_ALWAYS = "always"
+BATCH_MODES = (BATCH_MODE_OFF, BATCH_MODE_REPROCESS, BATCH_MODE_ALWAYS)
+
+# Default for projects without ai_config.batch_mode
+BATCH_MODE_DEFAULT = os.environ.get('BATCH_MODE_DEFAULT', BATCH_MODE_OFF)
+BATCH_COMPLETION_WINDOW = os.environ.get('BATCH_COMPLETION_WINDOW', '24h')
+BATCH_ENDPOINT = "/v1/chat/completions"
+
+# poll() states
+BATCH_IN_PROGRESS = "IN_PROGRESS"   # validating / in_progress / finalizing / cancelling
+BATCH_ENDED = "ENDED"               # completed / expired / cancelled / failed - results are final
+
+_ENDED_STATUSES = ('completed', 'expired', 'cancelled', 'failed')
+
+
+def batch_mode(ai_config: Optional[Dict[str, Any]]) -> str:
+    """The project's batch mode (unknown values fall back to the default)."""
+    mode = str((ai_config or {}).get('batch_mode') or BATCH_MODE_DEFAULT).lower()
+    if mode not in BATCH_MODES:
+        logger.warning(f"Unknown batch mode '{mode}', using '{BATCH_MODE_DEFAULT}'.")
+        mode = BATCH_MODE_DEFAULT if BATCH_MODE_DEFAULT in BATCH_MODES else BATCH_MODE_OFF
+    return mode
+
+
+def use_batch(ai_config: Optional[Dict[str, Any]], backend: str, reprocess: bool = False) -> bool:
+    """True if this reply should go through a batch instead of an interactive request."""
+    mode = batch_mode(ai_config)
+    if mode == BATCH_MODE_OFF or (mode == BATCH_MODE_REPROCESS and not reprocess):
+        return False
+    if backend != 'chat_completions':
+        logger.warning(f"Batch mode '{mode}' needs the chat_completions backend (project uses '{backend}'). Replying interactively.")
+        return False
+    return True
+
+
+def new_custom_id(conversation_id: str) -> str:
+    """A batch request ID for one reply of a conversation (unique per attempt)."""
+    return f"{conversation_id}:{uuid.uuid4().hex[:12]}"
+
+
+def build_request(
+    assistant_id: str,
+    user_message_content: str,
+    api_key: str,
+    history: Optional[List[Dict[str, Any]]] = None,
+    window: Optional[Dict[str, Any]] = None
+) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """
+    The chat.completions body of one batch request, built as the
+    chat_completions backend builds its prompt (window limits the history).
+
+    Returns:
+        (AI_SUCCESS, body), or an error status with {"error_message": ...}.
+    """
+    if not all([assistant_id, user_message_content, api_key]):
+        error_msg = "Missing required arguments for building a batch request."
+        logger.error(error_msg)
+        return AI_INVALID_INPUT, {"error_message": error_msg}
+
+    additional_instructions = None
+    if window:
+        history = context_window.recent_history(window, history)
+        additional_instructions = context_window.summary_instructions(window)
+    try:
+        client = key_pool.client(api_key)
+        body = chat_completions_service.build_request(client, assistant_id, user_message_content, history,
+                                                      additional_instructions)
+        return AI_SUCCESS, body
+    except openai.APIError as e:
+        error_msg = f"OpenAI API Error building batch request for assistant {assistant_id}: ({type(e).__name__}) {e}"
+        logger.error(error_msg)
+        return _api_error_status(e), {"error_message": error_msg}
+    except Exception as e:
+        error_msg = f"Unexpected error building batch request for assistant {assistant_id}: {e}"
+        logger.exception(error_msg)
+        return AI_NON_TRANSIENT_ERROR, {"error_message": error_msg}
+
+
+def to_jsonl(requests: List[Dict[str, Any]]) -> bytes:
+    """The batch input file for [{'custom_id': ..., 'body': {...}}, ...]."""
+    lines = [json.dumps({'custom_id': request['custom_id'], 'method': 'POST', 'url': BATCH_ENDPOINT,
+                         'body': request['body']}, separators=(',', ':'))
+             for request in requests]
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def submit(api_key: str, requests: List[Dict[str, Any]],
+           metadata: Optional[Dict[str, str]] = None) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """
+    Uploads the requests as a JSONL file and creates a batch over it. Every
+    request of a batch must use the same model.
+
+    Returns:
+        (AI_SUCCESS, {'batch_id', 'input_file_id', 'requests'}), or an error
+        status with {"error_message": ...}.
+    """
+    if not api_key or not requests:
+        error_msg = "Missing API key or requests for batch submission."
+        logger.error(error_msg)
+        return AI_INVALID_INPUT, {"error_message": error_msg}
+
+    content = to_jsonl(requests)
+    try:
+        client = key_pool.client(api_key)
+        with metrics.timer('batch_submit'):
+            input_file = client.files.create(file=('replies.jsonl', io.BytesIO(content)), purpose='batch')
+            batch = client.batches.create(input_file_id=input_file.id, endpoint=BATCH_ENDPOINT,
+                                          completion_window=BATCH_COMPLETION_WINDOW, metadata=metadata)
+        logger.info(f"Submitted batch {batch.id} with {len(requests)} requests ({len(content)} bytes, file {input_file.id}).")
+        metrics.put_metric('batch_requests_submitted', len(requests), metrics.UNIT_COUNT)
+        return AI_SUCCESS, {'batch_id': batch.id, 'input_file_id': input_file.id, 'requests': len(requests)}
+    except openai.APIError as e:
+        error_msg = f"OpenAI API Error submitting batch of {len(requests)} requests: ({type(e).__name__}) {e}"
+        logger.error(error_msg)
+        return _api_error_status(e), {"error_message": error_msg}
+    except Exception as e:
+        error_msg = f"Unexpected error submitting batch of {len(requests)} requests: {e}"
+        logger.exception(error_msg)
+        return AI_NON_TRANSIENT_ERROR, {"error_message": error_msg}
+
+
+def _result_status(status_code) -> str:
+    """A failed batch request's HTTP status -> AI status (rate limits and 5xx are worth retrying)."""
+    if status_code is None or status_code == 429 or status_code >= 500:
+        return AI_TRANSIENT_ERROR
+    return AI_NON_TRANSIENT_ERROR
+
+
+def parse_result_line(line: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+    """One line of a batch output / error file -> the (status, payload) an interactive request would return."""
+    response = line.get('response') or {}
+    status_code = response.get('status_code')
+    body = response.get('body') or {}
+    if status_code != 200:
+        error = line.get('error') or body.get('error') or {}
+        error_msg = f"Batch request {line.get('custom_id')} failed ({status_code}): {error.get('message') or error.get('code') or 'no details'}"
+        return _result_status(status_code), {"error_message": error_msg}
+
+    choices = body.get('choices') or []
+    content = ((choices[0] or {}).get('message') or {}).get('content') if choices else None
+    if not content:
+        return AI_NON_TRANSIENT_ERROR, {"error_message": f"Batch request {line.get('custom_id')} returned no content."}
+    usage = body.get('usage') or {}
+    return AI_SUCCESS, {
+        "response_content": content,
+        "prompt_tokens": usage.get('prompt_tokens', 0),
+        "completion_tokens": usage.get('completion_tokens', 0),
+        "total_tokens": usage.get('total_tokens', 0)
+    }
+
+
+def parse_results(text: str) -> Dict[str, Tuple[str, Dict[str, Any]]]:
+    """custom_id -> (status, payload) for every line of a batch output / error file."""
+    results = {}
+    for raw in (text or '').splitlines():
+        if not raw.strip():
+            continue
+        try:
+            line = json.loads(raw)
+        except json.JSONDecodeError:
+            logger.error(f"Skipping unreadable batch result line: {raw[:200]}")
+            continue
+        if line.get('custom_id'):
+            results[line['custom_id']] = parse_result_line(line)
+    return results
+
+
+def poll(api_key: str, batch_id: str) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """
+    Checks a batch. Once it has ended, its output and error files are read.
+
+    Returns:
+        (AI_SUCCESS, {'state': BATCH_IN_PROGRESS | BATCH_ENDED, 'status': the
+        batch's own status, 'results': custom_id -> (status, payload)}), or an
+        error status with {"error_message": ...}. Requests of an ended batch
+        without a result (expired, cancelled, failed validation) are missing
+        from 'results'.
+    """
+    if not api_key or not batch_id:
+        error_msg = "Missing API key or batch ID for batch poll."
+        logger.error(error_msg)
+        return AI_INVALID_INPUT, {"error_message": error_msg}
+
+    try:
+        client = key_pool.client(api_key)
+        batch = client.batches.retrieve(batch_id)
+        if batch.status not in _ENDED_STATUSES:
+            logger.info(f"Batch {batch_id} is {batch.status}.")
+            return AI_SUCCESS, {'state': BATCH_IN_PROGRESS, 'status': batch.status, 'results': {}}
+
+        results = {}
+        with metrics.timer('batch_results'):
+            for file_id in (getattr(batch, 'output_file_id', None), getattr(batch, 'error_file_id', None)):
+                if file_id:
+                    results.update(parse_results(client.files.content(file_id).text))
+        logger.info(f"Batch {batch_id} ended ({batch.status}) with {len(results)} results.")
+        return AI_SUCCESS, {'state': BATCH_ENDED, 'status': batch.status, 'results': results}
+    except openai.APIError as e:
+        error_msg = f"OpenAI API Error polling batch {batch_id}: ({type(e).__name__}) {e}"
+        logger.error(error_msg)
+        return _api_error_status(e), {"error_message": error_msg}
+    except Exception as e:
+        error_msg = f"Unexpected error polling batch {batch_id}: {e}"
+        logger.exception(error_msg)
+        return AI_NON_TRANSIENT_ERROR, {"error_message": error_msg}
+
+
+def missing_result(batch_status: str, custom_id: str) -> Tuple[str, Dict[str, Any]]:
+    """The outcome of a request an ended batch has no result for."""
+    error_msg = f"Batch ended ({batch_status}) without a result for {custom_id}."
+    # A batch that failed validation fails again; expired / cancelled ones are worth another try
+    return (AI_NON_TRANSIENT_ERROR if batch_status == 'failed' else AI_TRANSIENT_ERROR), {"error_message": error_msg}
@@ -0,0 +1,209 @@
+# core/chat_completions_service.py - Messaging Lambda (WhatsApp)
+"""
+Single-request AI backend: one chat.completions call per reply, with the
+prompt built from the conversation history stored in DynamoDB instead of an
+OpenAI thread.
+
+The assistant (`assistant_id_replies`) is still the source of the model,
+instructions and sampling settings. It is fetched with assistants.retrieve
+once per warm container and re-fetched after ASSISTANT_CACHE_TTL_SECONDS, so
+instruction edits are picked up without a deploy.
+
+Returns the same (status, payload) tuples as openai_service.process_reply_with_ai.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import openai
+
+from . import key_pool
+from ..utils import metrics
+from .openai_service import (
+    AI_SUCCESS, AI_NON_TRANSIENT_ERROR, AI_INVALID_INPUT, _api_error_status
+)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+
+ASSISTANT_CACHE_TTL_SECONDS = int(os.environ.get('ASSISTANT_CACHE_TTL_SECONDS', '900'))
+# Most recent history entries included in the prompt
+CHAT_HISTORY_MAX_MESSAGES = int(os.environ.get('CHAT_HISTORY_MAX_MESSAGES', '50'))
+# Used when the assistant has no model set
+CHAT_DEFAULT_MODEL = os.environ.get('CHAT_DEFAULT_MODEL', 'gpt-4o-mini')
+
+# assistant_id -> {'assistant': dict, 'loaded_at': epoch}
+_assistant_cache = {}
+_lock = threading.Lock()
+
+
+def _response_format(response_format) -> Optional[Dict[str, Any]]:
+    """The assistant's response_format as a chat.completions parameter (None for 'auto' / text)."""
+    kind = response_format if isinstance(response_format, str) else getattr(response_format, 'type', None)
+    if kind == 'json_object':
+        return {'type': 'json_object'}
+    if kind == 'json_schema' and hasattr(response_format, 'model_dump'):
+        return response_format.model_dump(exclude_none=True)
+    return None
+
+
+def get_assistant_settings(client, assistant_id: str) -> Dict[str, Any]:
+    """The assistant's model, instructions and sampling settings, cached per assistant_id."""
+    now = time.time()
+    with _lock:
+        entry = _assistant_cache.get(assistant_id)
+        if entry and now - entry['loaded_at'] < ASSISTANT_CACHE_TTL_SECONDS:
+            return entry['assistant']
+
+    with metrics.timer('ai_assistant_retrieve'):
+        assistant = client.beta.assistants.retrieve(assistant_id)
+    settings = {
+        'model': getattr(assistant, 'model', None) or CHAT_DEFAULT_MODEL,
+        'instructions': getattr(assistant, 'instructions', None) or '',
+        'temperature': getattr(assistant, 'temperature', None),
+        'top_p': getattr(assistant, 'top_p', None),
+        'response_format': _response_format(getattr(assistant, 'response_format', None)),
+    }
+    with _lock:
+        _assistant_cache[assistant_id] = {'assistant': settings, 'loaded_at': now}
+    logger.info(f"Cached settings of assistant {assistant_id} (model {settings['model']})")
+    return settings
+
+
+def build_messages(instructions: str, history: Optional[List[Dict[str, Any]]], user_message_content: str,
+                   max_history: Optional[int] = None, additional_instructions: Optional[str] = None) -> List[Dict[str, str]]:
+    """
+    Chat messages for one reply: the instructions (and any additional
+    instructions, such as a summary of older history), the most recent history
+    entries, then the new user message. Stored assistant entries hold the
+    extracted reply text, so they are re-wrapped in the {"content": ...} JSON
+    the assistants answer with.
+    """
+    max_history = CHAT_HISTORY_MAX_MESSAGES if max_history is None else max_history
+    messages = [{'role': 'system', 'content': instructions}] if instructions else []
+    if additional_instructions:
+        messages.append({'role': 'system', 'content': additional_instructions})
+    recent = (history or [])[-max_history:] if max_history > 0 else []
+    for entry in recent:
+        role, content = entry.get('role'), entry.get('content')
+        if role not in ('user', 'assistant') or not content:
+            continue
+        if role == 'assistant':
+            content = json.dumps({'content': content})
+        messages.append({'role': role, 'content': content})
+    messages.append({'role': 'user', 'content': user_message_content})
+    return messages
+
+
+def build_request(client, assistant_id: str, user_message_content: str,
+                  history: Optional[List[Dict[str, Any]]] = None,
+                  additional_instructions: Optional[str] = None) -> Dict[str, Any]:
+    """The chat.completions parameters for one reply (also the body of a Batch API request)."""
+    settings = get_assistant_settings(client, assistant_id)
+    messages = build_messages(settings['instructions'], history, user_message_content,
+                              additional_instructions=additional_instructions)
+    request = {'model': settings['model'], 'messages': messages}
+    for option in ('temperature', 'top_p', 'response_format'):
+        if settings[option] is not None:
+            request[option] = settings[option]
+    return request
+
+
+def process_reply_with_chat(
+    assistant_id: str,
+    user_message_content: str,
+    api_key: str,
+    history: Optional[List[Dict[str, Any]]] = None,
+    on_text: Optional[Callable[[str], None]] = None,
+    additional_instructions: Optional[str] = None
+) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """
+    Generates a reply with a single chat.completions request.
+
+    Args:
+        assistant_id: The assistant whose model and instructions to use.
+        user_message_content: The combined text from the user.
+        api_key: The OpenAI API key.
+        history: The conversation's stored messages (role / content maps), oldest first.
+        on_text: If given, the completion is streamed and on_text(delta) is
+                 called with each text fragment as it arrives.
+        additional_instructions: Added after the assistant's instructions.
+
+    Returns:
+        The same (status_code, result) tuple as openai_service.process_reply_with_ai.
+    """
+    if not all([assistant_id, user_message_content, api_key]):
+        error_msg = "Missing required arguments for OpenAI processing."
+        logger.error(error_msg)
+        return AI_INVALID_INPUT, {"error_message": error_msg}
+
+    try:
+        client = key_pool.client(api_key)
+    except Exception as e:
+        error_msg = f"Failed to initialize OpenAI client: {e}"
+        logger.exception(error_msg)
+        return AI_NON_TRANSIENT_ERROR, {"error_message": error_msg}
+
+    try:
+        request = build_request(client, assistant_id, user_message_content, history, additional_instructions)
+        logger.info(f"Requesting chat completion ({request['model']}, {len(request['messages'])} messages) for assistant {assistant_id}")
+
+        started = time.perf_counter()
+        usage = None
+        if on_text is None:
+            with metrics.timer('ai_completion'):
+                completion = client.chat.completions.create(**request)
+            choice = completion.choices[0] if completion.choices else None
+            content = choice.message.content if choice and choice.message else None
+            usage = completion.usage
+        else:
+            parts = []
+            deliver_text = True
+            with client.chat.completions.create(stream=True, stream_options={'include_usage': True}, **request) as stream:
+                for chunk in stream:
+                    if getattr(chunk, 'usage', None):
+                        usage = chunk.usage
+                    for choice in (chunk.choices or []):
+                        text = getattr(choice.delta, 'content', None) if choice.delta else None
+                        if not text:
+                            continue
+                        if not parts:
+                            metrics.put_metric('ai_first_token', round((time.perf_counter() - started) * 1000.0, 3))
+                        parts.append(text)
+                        if deliver_text:
+                            try:
+                                on_text(text)
+                            except Exception as e:
+                                logger.exception(f"Text callback failed for assistant {assistant_id}, continuing without it: {e}")
+                                deliver_text = False
+            content = ''.join(parts)
+            metrics.put_metric('ai_completion', round((time.perf_counter() - started) * 1000.0, 3))
+
+        if not content:
+            error_msg = f"Chat completion for assistant {assistant_id} returned no content."
+            logger.error(error_msg)
+            return AI_NON_TRANSIENT_ERROR, {"error_message": error_msg}
+
+        prompt_tokens = usage.prompt_tokens if usage else 0
+        completion_tokens = usage.completion_tokens if usage else 0
+        total_tokens = usage.total_tokens if usage else 0
+        logger.info(f"Chat completion successful for assistant {assistant_id}. Tokens: P{prompt_tokens}/C{completion_tokens}/T{total_tokens}")
+        return AI_SUCCESS, {
+            "response_content": content,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": total_tokens
+        }
+
+    except openai.APIError as e:
+        error_msg = f"OpenAI API Error requesting chat completion for assistant {assistant_id}: ({type(e).__name__}) {e}"
+        logger.error(error_msg)
+        return _api_error_status(e), {"error_message": error_msg}
+    except Exception as e:
+        error_msg = f"Unexpected error during chat completion for assistant {assistant_id}: {e}"
+        logger.exception(error_msg)
+        return AI_NON_TRANSIENT_ERROR, {"error_message": error_msg}
@@ -0,0 +1,174 @@
+# core/context_window.py - Messaging Lambda (WhatsApp)
+"""
+Keeps the prompt of long conversations within a token budget.
+
+The final update records each reply's prompt tokens on the conversation item
+(`context_tokens`) and adds its total to `total_tokens_used`. Once a reply's
+prompt goes over the project's budget, the conversation gets a `context_window`
+map and from then on the prompt only covers recent history:
+
+    truncate   the last `keep_last_messages` history entries
+    summarize  a rolling summary of older entries plus the entries after it
+               (between keep_last_messages and twice that). The summary is
+               extended after the reply has been sent, once enough entries
+               have piled up behind it, with one chat.completions call.
+
+For the threads backend this becomes the run's truncation_strategy (and the
+summary its additional_instructions); the chat_completions backend slices the
+history it builds the prompt from.
+
+Per-project settings live in `ai_config.context_window`:
+    {"max_prompt_tokens": 6000, "strategy": "summarize", "keep_last_messages": 10}
+"""
+
+import logging
+import os
+from typing import Any, Dict, List, Optional
+
+from . import key_pool
+from ..utils import metrics
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+
+STRATEGY_TRUNCATE = "truncate"
+STRATEGY_SUMMARIZE = "summarize"
+STRATEGIES = (STRATEGY_TRUNCATE, STRATEGY_SUMMARIZE)
+
+# Defaults for projects without ai_config.context_window (0 = no budget)
+CONTEXT_MAX_PROMPT_TOKENS = int(os.environ.get('CONTEXT_MAX_PROMPT_TOKENS', '0'))
+CONTEXT_STRATEGY = os.environ.get('CONTEXT_STRATEGY', STRATEGY_TRUNCATE)
+CONTEXT_KEEP_LAST_MESSAGES = int(os.environ.get('CONTEXT_KEEP_LAST_MESSAGES', '10'))
+CONTEXT_SUMMARY_MODEL = os.environ.get('CONTEXT_SUMMARY_MODEL', 'gpt-4o-mini')
+CONTEXT_SUMMARY_MAX_TOKENS = int(os.environ.get('CONTEXT_SUMMARY_MAX_TOKENS', '400'))
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a WhatsApp conversation between a candidate (user) "
+    "and a recruiting assistant. Update the summary with the new messages. Keep names, dates, "
+    "the candidate's answers and preferences, commitments made and open questions. "
+    "Reply with the summary as plain text, in the conversation's language."
+)
+SUMMARY_HEADER = "Summary of the earlier conversation (those messages are not shown):"
+
+
+def _int(value, default):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def plan(ai_config: Optional[Dict[str, Any]], conversation_item: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    The context window for a conversation's next reply, from the project's budget
+    and the state stored on the conversation item.
+    """
+    settings = (ai_config or {}).get('context_window') or {}
+    strategy = settings.get('strategy') or CONTEXT_STRATEGY
+    if strategy not in STRATEGIES:
+        logger.warning(f"Unknown context strategy '{strategy}', using '{STRATEGY_TRUNCATE}'.")
+        strategy = STRATEGY_TRUNCATE
+    state = conversation_item.get('context_window') or None
+    return {
+        'max_prompt_tokens': _int(settings.get('max_prompt_tokens'), CONTEXT_MAX_PROMPT_TOKENS),
+        'strategy': strategy,
+        'keep': max(1, _int(settings.get('keep_last_messages'), CONTEXT_KEEP_LAST_MESSAGES)),
+        'active': state is not None,
+        'summary': (state or {}).get('summary') or None,
+        'covers': _int((state or {}).get('covers'), 0),
+    }
+
+
+def _recent_limit(window: Dict[str, Any]) -> int:
+    """How many of the latest history entries the prompt includes while the window is active."""
+    return window['keep'] * 2 if window['strategy'] == STRATEGY_SUMMARIZE else window['keep']
+
+
+def summary_instructions(window: Dict[str, Any]) -> Optional[str]:
+    """The rolling summary as text to add to the instructions, or None."""
+    if not window['active'] or not window['summary']:
+        return None
+    return f"{SUMMARY_HEADER}\n{window['summary']}"
+
+
+def run_options(window: Dict[str, Any]) -> Dict[str, Any]:
+    """Extra runs.create parameters for the threads backend."""
+    if not window['active']:
+        return {}
+    # +1: the new user message is the last message of the thread
+    options = {'truncation_strategy': {'type': 'last_messages', 'last_messages': _recent_limit(window) + 1}}
+    instructions = summary_instructions(window)
+    if instructions:
+        options['additional_instructions'] = instructions
+    return options
+
+
+def recent_history(window: Dict[str, Any], history: Optional[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """The part of the stored history the chat_completions prompt includes."""
+    history = history or []
+    if not window['active']:
+        return history
+    if window['strategy'] == STRATEGY_SUMMARIZE and window['summary']:
+        history = history[window['covers']:]
+    return history[-_recent_limit(window):]
+
+
+def activation(window: Dict[str, Any], prompt_tokens: Optional[int]) -> Optional[Dict[str, Any]]:
+    """
+    The context_window state to store with a reply whose prompt reached the
+    budget, or None if there is no budget or the window is already active.
+    """
+    if window['active'] or window['max_prompt_tokens'] <= 0:
+        return None
+    if _int(prompt_tokens, 0) < window['max_prompt_tokens']:
+        return None
+    logger.info(f"Prompt of {prompt_tokens} tokens reached the budget of {window['max_prompt_tokens']}; "
+                f"limiting context ({window['strategy']}).")
+    metrics.put_metric('context_window_activated', 1, metrics.UNIT_COUNT)
+    return {'strategy': window['strategy'], 'covers': 0}
+
+
+def needs_compaction(window: Dict[str, Any], history_length: int) -> bool:
+    """True once twice keep_last_messages entries are not yet in the rolling summary."""
+    return (window['active'] and window['strategy'] == STRATEGY_SUMMARIZE
+            and history_length - window['covers'] >= window['keep'] * 2)
+
+
+def _transcript(entries: List[Dict[str, Any]]) -> str:
+    lines = []
+    for entry in entries:
+        if entry.get('role') in ('user', 'assistant') and entry.get('content'):
+            lines.append(f"{entry['role']}: {entry['content']}")
+    return "\n".join(lines)
+
+
+def compact(window: Dict[str, Any], history: List[Dict[str, Any]], api_key: str) -> Optional[Dict[str, Any]]:
+    """
+    Folds the history entries older than the last keep_last_messages into the
+    rolling summary. Returns the new context_window state, or None if the
+    summary could not be generated (the next reply tries again).
+    """
+    covers = len(history) - window['keep']
+    entries = history[window['covers']:covers]
+    if not entries:
+        return None
+    content = f"New messages:\n{_transcript(entries)}"
+    if window['summary']:
+        content = f"Current summary:\n{window['summary']}\n\n{content}"
+    try:
+        client = key_pool.client(api_key)
+        with metrics.timer('context_summarize'):
+            completion = client.chat.completions.create(
+                model=CONTEXT_SUMMARY_MODEL,
+                messages=[{'role': 'system', 'content': SUMMARY_PROMPT}, {'role': 'user', 'content': content}],
+                max_tokens=CONTEXT_SUMMARY_MAX_TOKENS
+            )
+        summary = completion.choices[0].message.content if completion.choices else None
+    except Exception as e:
+        logger.warning(f"Could not summarize {len(entries)} history entries: ({type(e).__name__}) {e}")
+        return None
+    if not summary:
+        logger.warning("Summary request returned no content.")
+        return None
+    logger.info(f"Summarized history entries {window['covers']}-{covers} into {len(summary)} characters.")
+    return {'strategy': STRATEGY_SUMMARIZE, 'covers': covers, 'summary': summary.strip()}
@@ -0,0 +1,306 @@
+# core/key_pool.py - Messaging Lambda (WhatsApp)
+"""
+Spreads OpenAI requests over a project's API keys and keeps each key under its
+rate limits, instead of finding them through RateLimitError and a full SQS
+redelivery.
+
+The OpenAI secret holds one key (`ai_api_key`) or a pool (`ai_api_keys`, a
+list; both may be set). A reply leases a key for the whole AI call:
+
+    with key_pool.lease(key_pool.api_keys(secret)) as api_key:
+        ...   # None: every key is rate limited, retry later
+
+Clients built with `client(api_key)` report every response to the pool, and
+hold requests on a blocked key until it recovers (`pace`). The pool keeps per
+key, per warm container:
+
+    concurrency limit  AIMD: +1/limit per successful response while the key is
+                       used up to its limit, x KEY_POOL_DECREASE_FACTOR (at most
+                       once per KEY_POOL_DECREASE_INTERVAL_SECONDS) on a 429 or
+                       when x-ratelimit-remaining-requests drops below the
+                       requests already in flight
+    blocked until      retry-after(-ms) of a 429, or, once x-ratelimit-remaining-
+                       requests is down to the requests in flight (tokens: to
+                       0), until one request's share of x-ratelimit-reset-*
+                       has passed
+
+A lease takes the usable key with the lowest share of its limit in flight
+(then the most remaining requests, then the least recently leased), waiting up
+to KEY_POOL_MAX_WAIT_SECONDS for one to free up.
+
+Keys of a pool must be interchangeable: with the threads backend every key
+must be able to access the conversation's thread (keys of one OpenAI project).
+Pools spanning projects, and so their separate limits, suit chat_completions.
+"""
+
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+import openai
+
+from ..utils import metrics
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+
+# --- Configuration ---
+KEY_POOL_ENABLED = os.environ.get('KEY_POOL_ENABLED', 'true').lower() == 'true'
+KEY_POOL_INITIAL_CONCURRENCY = float(os.environ.get('KEY_POOL_INITIAL_CONCURRENCY', '8'))
+KEY_POOL_MAX_CONCURRENCY = float(os.environ.get('KEY_POOL_MAX_CONCURRENCY', '64'))
+KEY_POOL_DECREASE_FACTOR = float(os.environ.get('KEY_POOL_DECREASE_FACTOR', '0.5'))
+KEY_POOL_DECREASE_INTERVAL_SECONDS = float(os.environ.get('KEY_POOL_DECREASE_INTERVAL_SECONDS', '1'))
+# Block after a 429 that carries no retry-after / reset header
+KEY_POOL_DEFAULT_BACKOFF_SECONDS = float(os.environ.get('KEY_POOL_DEFAULT_BACKOFF_SECONDS', '1'))
+KEY_POOL_MAX_WAIT_SECONDS = float(os.environ.get('KEY_POOL_MAX_WAIT_SECONDS', '20'))
+KEY_POOL_POLL_SECONDS = float(os.environ.get('KEY_POOL_POLL_SECONDS', '0.25'))
+
+# api key -> state (see _state)
+_keys = {}
+# api key -> httpx client reporting its responses to the pool
+_http_clients = {}
+_lock = threading.Lock()
+
+_DURATION_PART = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+_DURATION_SECONDS = {'ms': 0.001, 's': 1.0, 'm': 60.0, 'h': 3600.0}
+
+
+def api_keys(secret: Optional[Dict[str, Any]]) -> List[str]:
+    """The API keys in an OpenAI secret: ai_api_key, then ai_api_keys, without duplicates."""
+    secret = secret or {}
+    pool = secret.get('ai_api_keys') or []
+    if isinstance(pool, str):
+        pool = [pool]
+    keys = []
+    for key in [secret.get('ai_api_key')] + list(pool):
+        if isinstance(key, str) and key and key not in keys:
+            keys.append(key)
+    return keys
+
+
+def _label(api_key: str) -> str:
+    """How a key appears in logs."""
+    return f"...{api_key[-4:]}"
+
+
+def _state(api_key: str) -> Dict[str, Any]:
+    """The key's state, created on first use (call with _lock held)."""
+    state = _keys.get(api_key)
+    if state is None:
+        state = _keys[api_key] = {
+            'limit': KEY_POOL_INITIAL_CONCURRENCY,
+            'in_flight': 0,
+            'blocked_until': 0.0,
+            'remaining_requests': None,
+            'remaining_tokens': None,
+            'leased_at': 0.0,
+            'decreased_at': None,
+            'interval': 0.0,
+            'next_slot': 0.0,
+        }
+    return state
+
+
+def key_state(api_key: str) -> Dict[str, Any]:
+    """A copy of the pool's state for a key."""
+    with _lock:
+        return dict(_state(api_key))
+
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """Seconds in an x-ratelimit-reset-* value such as '1s', '6m0s' or '20ms' (None if absent/invalid)."""
+    if not value:
+        return None
+    parts = _DURATION_PART.findall(str(value))
+    if not parts:
+        return None
+    return sum(float(number) * _DURATION_SECONDS[unit] for number, unit in parts)
+
+
+def _int_header(headers, name):
+    try:
+        return int(headers.get(name))
+    except (TypeError, ValueError):
+        return None
+
+
+def _retry_after(headers) -> Optional[float]:
+    """Seconds to wait from retry-after-ms / retry-after (None if neither is usable)."""
+    try:
+        return float(headers.get('retry-after-ms')) / 1000.0
+    except (TypeError, ValueError):
+        pass
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+def _recovery(headers, kind, remaining, reserve=0):
+    """
+    Seconds to hold requests once a limit ('requests' / 'tokens') is down to
+    `reserve` remaining. x-ratelimit-reset-* is the time until the whole limit
+    is restored; with x-ratelimit-limit-* known, only one unit's share of it.
+    """
+    reset = parse_duration(headers.get(f'x-ratelimit-reset-{kind}'))
+    if remaining is None or remaining > reserve or not reset:
+        return None
+    limit = _int_header(headers, f'x-ratelimit-limit-{kind}')
+    return reset / limit if limit else reset
+
+
+def _decrease(state, now):
+    """Multiplicative decrease, once per congestion event."""
+    if state['decreased_at'] is not None and now - state['decreased_at'] < KEY_POOL_DECREASE_INTERVAL_SECONDS:
+        return
+    state['limit'] = max(1.0, state['limit'] * KEY_POOL_DECREASE_FACTOR)
+    state['decreased_at'] = now
+
+
+def observe(api_key: str, status_code: int, headers) -> None:
+    """Updates a key's limit and availability from one API response."""
+    if not KEY_POOL_ENABLED or not api_key:
+        return
+    now = time.time()
+    remaining_requests = _int_header(headers, 'x-ratelimit-remaining-requests')
+    remaining_tokens = _int_header(headers, 'x-ratelimit-remaining-tokens')
+
+    with _lock:
+        state = _state(api_key)
+        # Keys about to run out (or throttled) are held until the API says they recover
+        waits = [wait for wait in (_recovery(headers, 'requests', remaining_requests, state['in_flight']),
+                                   _recovery(headers, 'tokens', remaining_tokens)) if wait]
+        interval = max(waits) if waits else None
+        if remaining_requests is not None:
+            state['remaining_requests'] = remaining_requests
+        if remaining_tokens is not None:
+            state['remaining_tokens'] = remaining_tokens
+        if status_code == 429:
+            retry_after = _retry_after(headers)
+            waits = [retry_after] if retry_after is not None else (waits or [KEY_POOL_DEFAULT_BACKOFF_SECONDS])
+            _decrease(state, now)
+        elif 200 <= status_code < 300:
+            if remaining_requests is not None and remaining_requests < state['in_flight']:
+                _decrease(state, now)
+            elif state['in_flight'] >= int(state['limit']):
+                state['limit'] = min(KEY_POOL_MAX_CONCURRENCY, state['limit'] + 1.0 / state['limit'])
+        if interval is not None:
+            state['interval'] = interval
+        if waits:
+            state['blocked_until'] = max(state['blocked_until'], now + max(waits))
+        limit, blocked_for = state['limit'], state['blocked_until'] - now
+
+    if status_code == 429:
+        logger.warning(f"OpenAI key {_label(api_key)} rate limited; blocked for {blocked_for:.1f}s, concurrency limit {limit:.1f}.")
+        metrics.put_metric('openai_key_throttled', 1, metrics.UNIT_COUNT)
+
+
+def pace(api_key: str) -> None:
+    """
+    Holds a request on a blocked key until the key recovers, instead of letting
+    it bounce off the limit. Requests waiting on the same key are released one
+    recovery interval apart (at most KEY_POOL_MAX_WAIT_SECONDS each).
+    """
+    if not KEY_POOL_ENABLED:
+        return
+    with _lock:
+        state = _state(api_key)
+        now = time.time()
+        if state['blocked_until'] <= now:
+            return
+        slot = max(state['blocked_until'], state['next_slot'])
+        state['next_slot'] = slot + state['interval']
+    wait = min(slot - now, KEY_POOL_MAX_WAIT_SECONDS)
+    metrics.put_metric('openai_key_paced', round(wait * 1000.0, 3))
+    time.sleep(wait)
+
+
+def _http_client(api_key: str):
+    """The key's httpx client (cached, so its connections are reused by the container's later requests)."""
+    with _lock:
+        http_client = _http_clients.get(api_key)
+        if http_client is None:
+            http_client = _http_clients[api_key] = openai.DefaultHttpxClient(event_hooks={
+                'request': [lambda request: pace(api_key)],
+                'response': [lambda response: observe(api_key, response.status_code, response.headers)],
+            })
+        return http_client
+
+
+def client(api_key: str) -> openai.OpenAI:
+    """An OpenAI client for api_key whose responses update the pool."""
+    if not KEY_POOL_ENABLED:
+        return openai.OpenAI(api_key=api_key)
+    return openai.OpenAI(api_key=api_key, http_client=_http_client(api_key))
+
+
+def _pick(keys: List[str], now: float) -> Optional[str]:
+    """The usable key with the most headroom (call with _lock held)."""
+    best, best_rank = None, None
+    for key in keys:
+        state = _state(key)
+        if state['blocked_until'] > now or state['in_flight'] >= max(1, int(state['limit'])):
+            continue
+        remaining = state['remaining_requests']
+        rank = (state['in_flight'] / state['limit'], -(remaining if remaining is not None else float('inf')), state['leased_at'])
+        if best_rank is None or rank < best_rank:
+            best, best_rank = key, rank
+    return best
+
+
+def _next_change(keys: List[str], now: float) -> float:
+    """Seconds until a blocked key unblocks, capped at KEY_POOL_POLL_SECONDS (call with _lock held)."""
+    unblocks = [_state(key)['blocked_until'] - now for key in keys if _state(key)['blocked_until'] > now]
+    return min([KEY_POOL_POLL_SECONDS] + unblocks)
+
+
+@contextmanager
+def lease(keys: List[str]):
+    """
+    Yields the key to use for one AI call and counts it as in flight until the
+    block exits. Yields None if no key became usable within
+    KEY_POOL_MAX_WAIT_SECONDS (or keys is empty).
+    """
+    if not keys:
+        yield None
+        return
+    if not KEY_POOL_ENABLED:
+        yield keys[0]
+        return
+
+    started = time.time()
+    deadline = started + KEY_POOL_MAX_WAIT_SECONDS
+    while True:
+        now = time.time()
+        with _lock:
+            key = _pick(keys, now)
+            if key is not None:
+                state = _state(key)
+                state['in_flight'] += 1
+                state['leased_at'] = now
+                break
+            pause = _next_change(keys, now)
+        if now >= deadline:
+            break
+        time.sleep(max(0.0, min(pause, deadline - now)))
+
+    waited = time.time() - started
+    if waited > 0:
+        metrics.put_metric('openai_key_wait', round(waited * 1000.0, 3))
+    if key is None:
+        logger.warning(f"No OpenAI key of {len(keys)} usable after {waited:.1f}s.")
+        metrics.put_metric('openai_key_exhausted', 1, metrics.UNIT_COUNT)
+        yield None
+        return
+    if len(keys) > 1:
+        logger.info(f"Leased OpenAI key {_label(key)} ({keys.index(key) + 1} of {len(keys)}).")
+    try:
+        yield key
+    finally:
+        with _lock:
+            state = _state(key)
+            state['in_flight'] = max(0, state['in_flight'] - 1)
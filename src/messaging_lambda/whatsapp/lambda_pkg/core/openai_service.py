@@ -1,10 +1,14 @@
 # core/openai_service.py - Messaging Lambda (WhatsApp)
 
 import openai
+import json
 import logging
 import os
 import time
-from typing import Dict, Any, Optional, Tuple
+from typing import Callable, Dict, Any, List, Optional, Tuple
+
+from . import key_pool
+from ..utils import metrics
 
 logger = logging.getLogger(__name__)
 logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
@@ -16,6 +20,73 @@ AI_NON_TRANSIENT_ERROR = "NON_TRANSIENT_ERROR" # Auth, Not Found, Bad Request, F
 AI_INVALID_INPUT = "INVALID_INPUT"           # Missing required args to this function
 # --- End Status Codes --- #
 
+# Streamed runs end with one of these events (thread.run.completed is success)
+RUN_TERMINAL_FAILURE_EVENTS = ('thread.run.failed', 'thread.run.cancelled', 'thread.run.expired')
+STREAM_TIMEOUT_SECONDS = 540 # Same budget as polling
+
+def _api_error_status(e):
+    """Maps an openai.APIError to AI_TRANSIENT_ERROR (timeouts, rate limits, 5xx) or AI_NON_TRANSIENT_ERROR."""
+    if isinstance(e, (
+        openai.RateLimitError,
+        openai.APIConnectionError,
+        openai.Timeout,
+        openai.InternalServerError
+    )):
+        return AI_TRANSIENT_ERROR
+    # Treat all other API errors (Auth, Permission, NotFound, BadRequest, etc.) as non-transient
+    return AI_NON_TRANSIENT_ERROR
+
+# Page size for listing a run's messages (the API maximum)
+RUN_MESSAGES_PAGE_LIMIT = 100
+
+
+def message_text(message) -> Optional[str]:
+    """The text of a thread message: its text content blocks joined in order (None if it has none)."""
+    parts = [block.text.value for block in (getattr(message, 'content', None) or [])
+             if getattr(block, 'type', None) == 'text' and getattr(block, 'text', None) is not None]
+    return ''.join(parts) if parts else None
+
+
+def combine_reply_texts(texts: List[str]) -> str:
+    """
+    One reply from the text of every assistant message a run created. When each
+    message is the assistants' {"content": ...} JSON, the contents are joined
+    into a single such object, so the reply still parses.
+    """
+    if len(texts) == 1:
+        return texts[0]
+    contents = []
+    for text in texts:
+        try:
+            parsed = json.loads(text)
+        except ValueError:
+            return "\n\n".join(texts)
+        if not isinstance(parsed, dict) or not isinstance(parsed.get('content'), str):
+            return "\n\n".join(texts)
+        contents.append(parsed['content'])
+    return json.dumps({'content': "\n\n".join(contents)})
+
+
+def list_run_messages(client, thread_id: str, run_id: str) -> List[Any]:
+    """
+    The assistant messages created by run_id, oldest first. Lists with the
+    run_id filter, so earlier thread history is never transferred, and follows
+    pagination for runs that create many messages.
+    """
+    messages = []
+    after = None
+    while True:
+        params = {'thread_id': thread_id, 'run_id': run_id, 'order': 'asc', 'limit': RUN_MESSAGES_PAGE_LIMIT}
+        if after:
+            params['after'] = after
+        page = client.beta.threads.messages.list(**params)
+        data = list(page.data or [])
+        messages.extend(m for m in data if m.role == 'assistant' and m.run_id == run_id)
+        if not data or not getattr(page, 'has_more', False):
+            return messages
+        after = data[-1].id
+
+
 # Define polling parameters - REMOVED ENV VARS
 # POLLING_INTERVAL_SECONDS = int(os.environ.get('OPENAI_POLLING_INTERVAL', '1')) # Default 1 second - REMOVED
 # RUN_TIMEOUT_SECONDS = int(os.environ.get('OPENAI_RUN_TIMEOUT', '540')) # Default 9 minutes - REMOVED
@@ -24,7 +95,8 @@ def process_reply_with_ai(
     thread_id: str,
     assistant_id: str,
     user_message_content: str,
-    api_key: str
+    api_key: str,
+    run_options: Optional[Dict[str, Any]] = None
 ) -> Tuple[str, Optional[Dict[str, Any]]]:
     """
     Adds a user message to an existing OpenAI thread, runs the specified assistant,
@@ -35,6 +107,8 @@ def process_reply_with_ai(
         assistant_id: The OpenAI assistant ID configured for handling replies.
         user_message_content: The combined text from the user.
         api_key: The OpenAI API key.
+        run_options: Extra runs.create parameters (e.g. truncation_strategy,
+                     additional_instructions from core/context_window.py).
 
     Returns:
         A tuple containing:
@@ -52,7 +126,7 @@ def process_reply_with_ai(
 
     # Initialize OpenAI Client
     try:
-        client = openai.OpenAI(api_key=api_key)
+        client = key_pool.client(api_key)
         logger.debug("OpenAI client initialized.")
     except Exception as e:
         error_msg = f"Failed to initialize OpenAI client: {e}"
@@ -66,19 +140,22 @@ def process_reply_with_ai(
         # 1. Add the new user message to the existing thread
         logger.info(f"Adding user message to thread {thread_id}")
         logger.debug(f"User message content: {user_message_content[:200]}...")
-        message = client.beta.threads.messages.create(
-            thread_id=thread_id,
-            role="user",
-            content=user_message_content
-        )
+        with metrics.timer('ai_message_create'):
+            message = client.beta.threads.messages.create(
+                thread_id=thread_id,
+                role="user",
+                content=user_message_content
+            )
         logger.info(f"Successfully added message {message.id} to thread {thread_id}")
 
         # 2. Run the assistant on the thread
         logger.info(f"Running assistant {assistant_id} on thread {thread_id}")
-        run = client.beta.threads.runs.create(
-            thread_id=thread_id,
-            assistant_id=assistant_id
-        )
+        with metrics.timer('ai_run_create'):
+            run = client.beta.threads.runs.create(
+                thread_id=thread_id,
+                assistant_id=assistant_id,
+                **(run_options or {})
+            )
         run_id = run.id
         logger.info(f"Created run {run_id} with status {run.status}")
 
@@ -88,6 +165,8 @@ def process_reply_with_ai(
         polling_interval_seconds = 1  # Hardcoded 1 second
         logger.info(f"Polling run {run_id} status (timeout: {polling_timeout_seconds}s)... ")
         start_time = time.time()
+        poll_timer_start = time.perf_counter()
+        poll_count = 0
         while True:
             elapsed_time = time.time() - start_time
             # Use the hardcoded timeout value
@@ -99,10 +178,13 @@ def process_reply_with_ai(
                 return AI_TRANSIENT_ERROR, {"error_message": error_msg} # Timeout is transient
             
             run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run_id)
+            poll_count += 1
             logger.debug(f"Run {run_id} status: {run.status}")
 
             if run.status == 'completed':
                 logger.info(f"Run {run_id} completed successfully.")
+                metrics.put_metric('ai_run_poll', round((time.perf_counter() - poll_timer_start) * 1000.0, 3))
+                metrics.put_metric('ai_run_poll_count', poll_count, metrics.UNIT_COUNT)
                 break
             elif run.status in ['failed', 'cancelled', 'expired']:
                 error_msg = f"Run {run_id} ended with terminal status: {run.status}. Details: {run.last_error}"
@@ -116,33 +198,19 @@ def process_reply_with_ai(
             # Use the hardcoded interval value
             time.sleep(polling_interval_seconds)
 
-        # 4. Retrieve the latest messages from the thread
-        logger.info(f"Retrieving messages from thread {thread_id} after run {run_id}.")
-        messages_response = client.beta.threads.messages.list(thread_id=thread_id, order='desc')
-        thread_messages = messages_response.data
-
-        if not thread_messages:
-             error_msg = f"No messages found in thread {thread_id} after run {run_id} completed."
-             logger.error(error_msg)
-             return AI_NON_TRANSIENT_ERROR, {"error_message": error_msg}
-        logger.info(f"Retrieved {len(thread_messages)} messages from thread {thread_id}.")
-
-        # 5. Extract the relevant assistant response message
-        assistant_message_content = None
-        for m in thread_messages:
-            if m.run_id == run_id and m.role == 'assistant':
-                 if m.content and len(m.content) > 0 and hasattr(m.content[0], 'text'):
-                     assistant_message_content = m.content[0].text.value
-                     logger.info(f"Found assistant message {m.id} from run {run_id}.")
-                     break
-                 else:
-                      logger.warning(f"Assistant message {m.id} from run {run_id} found but has no text content.")
-                      break
-
-        if assistant_message_content is None:
+        # 4. Retrieve only the messages this run created
+        logger.info(f"Retrieving messages created by run {run_id} in thread {thread_id}.")
+        with metrics.timer('ai_messages_list'):
+            run_messages = list_run_messages(client, thread_id, run_id)
+        logger.info(f"Retrieved {len(run_messages)} assistant message(s) for run {run_id}.")
+
+        # 5. Combine their text into the reply
+        texts = [text for text in (message_text(m) for m in run_messages) if text]
+        if not texts:
             error_msg = f"No assistant message with text content found associated with run {run_id} in thread {thread_id}."
-            logger.error(error_msg + f" Messages dump: {thread_messages}")
+            logger.error(error_msg + f" Run messages: {[m.id for m in run_messages]}")
             return AI_NON_TRANSIENT_ERROR, {"error_message": error_msg}
+        assistant_message_content = combine_reply_texts(texts)
         logger.debug(f"Extracted assistant content: {assistant_message_content[:200]}...")
 
         # 6. Extract token usage from the final run object (must exist if completed)
@@ -163,19 +231,151 @@ def process_reply_with_ai(
     except openai.APIError as e: # Catch base OpenAI API errors
         error_msg = f"OpenAI API Error processing thread {thread_id}, run {run_id}: ({type(e).__name__}) {e}"
         logger.error(error_msg)
-        # Check for specific transient error types
-        if isinstance(e, (
-            openai.RateLimitError,
-            openai.APIConnectionError,
-            openai.Timeout,
-            openai.InternalServerError
-        )):
-            return AI_TRANSIENT_ERROR, {"error_message": error_msg}
-        else:
-            # Treat all other API errors (Auth, Permission, NotFound, BadRequest, etc.) as non-transient
-            return AI_NON_TRANSIENT_ERROR, {"error_message": error_msg}
+        return _api_error_status(e), {"error_message": error_msg}
     except Exception as e:
         error_msg = f"Unexpected error during OpenAI processing for thread {thread_id}, run {run_id}: {e}"
         logger.exception(error_msg)
         # Treat unexpected errors as non-transient for safety
-        return AI_NON_TRANSIENT_ERROR, {"error_message": error_msg} 
\ No newline at end of file
+        return AI_NON_TRANSIENT_ERROR, {"error_message": error_msg}
+
+def stream_reply_with_ai(
+    thread_id: str,
+    assistant_id: str,
+    user_message_content: str,
+    api_key: str,
+    on_text: Callable[[str], None],
+    run_options: Optional[Dict[str, Any]] = None
+) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """
+    Same as process_reply_with_ai, but runs the assistant as a streamed run:
+    on_text(delta) is called with each fragment of the reply's text as it is
+    generated, and no polling or messages.list round trip is needed.
+
+    Args:
+        thread_id: The existing OpenAI thread ID.
+        assistant_id: The OpenAI assistant ID configured for handling replies.
+        user_message_content: The combined text from the user.
+        api_key: The OpenAI API key.
+        on_text: Called with every text delta, in order. Errors it raises are
+                 logged and stop further calls; the run itself continues.
+        run_options: Extra runs.create parameters, as for process_reply_with_ai.
+
+    Returns:
+        The same (status_code, result) tuple as process_reply_with_ai.
+    """
+    logger.info(f"Starting streamed OpenAI processing for thread_id: {thread_id}, assistant_id: {assistant_id}")
+
+    if not all([thread_id, assistant_id, user_message_content, api_key]):
+        error_msg = "Missing required arguments for OpenAI processing."
+        logger.error(error_msg)
+        return AI_INVALID_INPUT, {"error_message": error_msg}
+
+    try:
+        client = key_pool.client(api_key)
+    except Exception as e:
+        error_msg = f"Failed to initialize OpenAI client: {e}"
+        logger.exception(error_msg)
+        return AI_NON_TRANSIENT_ERROR, {"error_message": error_msg}
+
+    run_id = None
+    try:
+        # 1. Add the new user message to the existing thread
+        with metrics.timer('ai_message_create'):
+            message = client.beta.threads.messages.create(
+                thread_id=thread_id,
+                role="user",
+                content=user_message_content
+            )
+        logger.info(f"Successfully added message {message.id} to thread {thread_id}")
+
+        # 2. Run the assistant as a stream of events
+        start_time = time.time()
+        stream_timer_start = time.perf_counter()
+        deltas = []
+        completed_texts = []
+        completed_run = None
+        deliver_text = True
+        with client.beta.threads.runs.create(thread_id=thread_id, assistant_id=assistant_id, stream=True,
+                                             **(run_options or {})) as stream:
+            for event in stream:
+                kind = getattr(event, 'event', None)
+                data = getattr(event, 'data', None)
+
+                if kind == 'thread.run.created':
+                    run_id = data.id
+                    logger.info(f"Created streamed run {run_id}")
+                elif kind == 'thread.message.delta':
+                    for block in (data.delta.content or []):
+                        text = getattr(getattr(block, 'text', None), 'value', None)
+                        if getattr(block, 'type', None) != 'text' or not text:
+                            continue
+                        if not deltas:
+                            metrics.put_metric('ai_first_token', round((time.perf_counter() - stream_timer_start) * 1000.0, 3))
+                        deltas.append(text)
+                        if deliver_text:
+                            try:
+                                on_text(text)
+                            except Exception as e:
+                                logger.exception(f"Text callback failed for run {run_id}, continuing without it: {e}")
+                                deliver_text = False
+                elif kind == 'thread.message.completed':
+                    text = message_text(data) if data.role == 'assistant' else None
+                    if text:
+                        completed_texts.append(text)
+                elif kind == 'thread.run.completed':
+                    completed_run = data
+                elif kind in RUN_TERMINAL_FAILURE_EVENTS:
+                    error_msg = f"Run {run_id} ended with terminal status: {data.status}. Details: {data.last_error}"
+                    logger.error(error_msg)
+                    return AI_NON_TRANSIENT_ERROR, {"error_message": error_msg}
+                elif kind == 'thread.run.requires_action':
+                    error_msg = f"Run {run_id} requires action, but function calling is not implemented."
+                    logger.error(error_msg)
+                    try: client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run_id)
+                    except Exception: logger.warning(f"Failed to cancel run {run_id}")
+                    return AI_NON_TRANSIENT_ERROR, {"error_message": error_msg}
+                elif kind == 'error':
+                    error_msg = f"OpenAI stream error for run {run_id}: {getattr(data, 'message', data)}"
+                    logger.error(error_msg)
+                    return AI_TRANSIENT_ERROR, {"error_message": error_msg}
+
+                if time.time() - start_time > STREAM_TIMEOUT_SECONDS:
+                    error_msg = f"Stream timeout exceeded for run {run_id} after {STREAM_TIMEOUT_SECONDS} seconds."
+                    logger.error(error_msg)
+                    try: client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run_id)
+                    except Exception: logger.warning(f"Failed to cancel timed-out run {run_id}")
+                    return AI_TRANSIENT_ERROR, {"error_message": error_msg}
+
+        metrics.put_metric('ai_run_stream', round((time.perf_counter() - stream_timer_start) * 1000.0, 3))
+        if completed_run is None:
+            error_msg = f"Stream for run {run_id} on thread {thread_id} ended before the run completed."
+            logger.error(error_msg)
+            return AI_TRANSIENT_ERROR, {"error_message": error_msg}
+
+        # 3. The completed messages are authoritative; the deltas are the fallback
+        assistant_message_content = combine_reply_texts(completed_texts) if completed_texts else ''.join(deltas)
+        if not assistant_message_content:
+            error_msg = f"No assistant text content streamed for run {run_id} in thread {thread_id}."
+            logger.error(error_msg)
+            return AI_NON_TRANSIENT_ERROR, {"error_message": error_msg}
+
+        usage = getattr(completed_run, 'usage', None)
+        prompt_tokens = usage.prompt_tokens if usage else 0
+        completion_tokens = usage.completion_tokens if usage else 0
+        total_tokens = usage.total_tokens if usage else 0
+        logger.info(f"Streamed OpenAI processing successful for thread {thread_id}. Tokens: P{prompt_tokens}/C{completion_tokens}/T{total_tokens}")
+        return AI_SUCCESS, {
+            "response_content": assistant_message_content,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": total_tokens
+        }
+
+    except openai.APIError as e:
+        error_msg = f"OpenAI API Error streaming thread {thread_id}, run {run_id}: ({type(e).__name__}) {e}"
+        logger.error(error_msg)
+        return _api_error_status(e), {"error_message": error_msg}
+    except Exception as e:
+        error_msg = f"Unexpected error during streamed OpenAI processing for thread {thread_id}, run {run_id}: {e}"
+        logger.exception(error_msg)
+        return AI_NON_TRANSIENT_ERROR, {"error_message": error_msg}
@@ -0,0 +1,178 @@
+# core/progressive_reply.py - Messaging Lambda (WhatsApp)
+
+"""
+Progressive reply delivery. While a streamed run is generating, the text of the
+reply's JSON `content` field is decoded as it arrives and sent as a separate
+WhatsApp message each time a paragraph or sentence is complete. The user sees
+the first part of the reply while the rest is still being generated.
+
+    reply = ProgressiveReply(send)         # send(body) -> (status, payload), e.g. a bound send_whatsapp_reply
+    openai_service.stream_reply_with_ai(..., on_text=reply.feed)
+    rest = reply.remainder(final_body)     # text not yet sent, to go out through the normal send
+
+Parts are sent one at a time, in order, from the streaming thread. If a send
+fails, no further parts are sent and everything after the last delivered part
+is left to remainder().
+"""
+
+import json
+import logging
+import os
+import re
+import time
+from typing import Callable, Dict, Any, List, Optional, Tuple
+
+from ..utils import metrics
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+
+# Default for companies whose ai_config has no 'progressive_replies' flag
+PROGRESSIVE_REPLIES_ENABLED = os.environ.get('PROGRESSIVE_REPLIES_ENABLED', 'false').lower() == 'true'
+# A sentence boundary only ends a part once the part is at least this long (paragraph breaks always do)
+PROGRESSIVE_MIN_PART_CHARS = int(os.environ.get('PROGRESSIVE_MIN_PART_CHARS', '60'))
+# Twilio's WhatsApp body limit; a part without a boundary is cut at the last space before it
+PROGRESSIVE_MAX_PART_CHARS = int(os.environ.get('PROGRESSIVE_MAX_PART_CHARS', '1600'))
+
+SEND_SUCCESS = "SUCCESS" # twilio_service.TWILIO_SUCCESS
+
+_CONTENT_FIELD_START = re.compile(r'"content"\s*:\s*"')
+_SENTENCE_END = re.compile(r'[.!?…]["\'\)\]]*\s')
+_PARAGRAPH_BREAK = '\n\n'
+
+
+def is_enabled(ai_config: Optional[Dict[str, Any]]) -> bool:
+    """True if replies for this conversation should be delivered progressively."""
+    flag = (ai_config or {}).get('progressive_replies')
+    if flag is None:
+        return PROGRESSIVE_REPLIES_ENABLED
+    return flag is True or str(flag).lower() == 'true'
+
+
+class ContentFieldDecoder:
+    """
+    Incrementally decodes the string value of the "content" field from JSON
+    text that arrives in arbitrary fragments. feed() returns the newly decoded
+    characters; escapes split across fragments (including surrogate pairs) are
+    held back until complete.
+    """
+
+    def __init__(self):
+        self._raw = ''
+        self._position = None   # Index in _raw of the next undecoded character of the value
+        self.done = False
+
+    def feed(self, fragment: str) -> str:
+        if self.done or not fragment:
+            return ''
+        self._raw += fragment
+        if self._position is None:
+            match = _CONTENT_FIELD_START.search(self._raw)
+            if not match:
+                return ''
+            self._position = match.end()
+
+        raw, i, decoded = self._raw, self._position, []
+        while i < len(raw):
+            char = raw[i]
+            if char == '"':
+                self.done = True
+                i += 1
+                break
+            if char != '\\':
+                decoded.append(char)
+                i += 1
+                continue
+            escape = self._complete_escape(raw, i)
+            if escape is None:
+                break
+            try:
+                decoded.append(json.loads(f'"{escape}"'))
+            except ValueError:
+                decoded.append(escape)
+            i += len(escape)
+        self._position = i
+        return ''.join(decoded)
+
+    @staticmethod
+    def _complete_escape(raw, i):
+        """The escape sequence starting at raw[i], or None if it hasn't fully arrived."""
+        if i + 1 >= len(raw):
+            return None
+        if raw[i + 1] != 'u':
+            return raw[i:i + 2]
+        if i + 6 > len(raw):
+            return None
+        try:
+            high_surrogate = 0xD800 <= int(raw[i + 2:i + 6], 16) <= 0xDBFF
+        except ValueError:
+            return raw[i:i + 6]
+        following = raw[i + 6:i + 8]
+        if high_surrogate and following in ('\\u', '\\', ''):
+            # Decode the pair together - it may still be arriving
+            if len(following) < 2 or i + 12 > len(raw):
+                return None
+            return raw[i:i + 12]
+        return raw[i:i + 6]
+
+
+class ProgressiveReply:
+    """Splits a streamed reply into parts and sends each one as soon as it is complete."""
+
+    def __init__(self, send: Callable[[str], Tuple[str, Optional[Dict[str, Any]]]],
+                 min_part_chars: Optional[int] = None, max_part_chars: Optional[int] = None):
+        self._send = send
+        self._min_part_chars = PROGRESSIVE_MIN_PART_CHARS if min_part_chars is None else min_part_chars
+        self._max_part_chars = PROGRESSIVE_MAX_PART_CHARS if max_part_chars is None else max_part_chars
+        self._decoder = ContentFieldDecoder()
+        self._pending = ''          # Decoded text not sent yet
+        self._sent_text = ''        # Decoded text covered by the parts sent (including whitespace between them)
+        self._started = time.perf_counter()
+        self.parts: List[Dict[str, Any]] = []   # Send payloads ({'message_sid', 'body'}) of the delivered parts
+        self.error: Optional[Tuple[str, Optional[Dict[str, Any]]]] = None
+
+    def feed(self, fragment: str) -> None:
+        """Takes the next fragment of the raw reply (as streamed) and sends any parts it completes."""
+        if self.error is not None:
+            return
+        self._pending += self._decoder.feed(fragment)
+        cut = self._next_cut(self._pending)
+        while cut is not None and self.error is None:
+            self._send_part(cut)
+            cut = self._next_cut(self._pending)
+
+    def _next_cut(self, text):
+        """Length of the prefix of `text` that forms the next part, or None if no part is complete yet."""
+        paragraph = text.find(_PARAGRAPH_BREAK)
+        if paragraph != -1 and paragraph < self._max_part_chars:
+            return paragraph + len(_PARAGRAPH_BREAK)
+        cut = None
+        for match in _SENTENCE_END.finditer(text, 0, self._max_part_chars):
+            if match.end() >= self._min_part_chars:
+                cut = match.end()
+        if cut is not None:
+            return cut
+        if len(text) > self._max_part_chars:
+            space = text.rfind(' ', 0, self._max_part_chars)
+            return space + 1 if space > 0 else self._max_part_chars
+        return None
+
+    def _send_part(self, cut):
+        body = self._pending[:cut].strip()
+        if body:
+            status, payload = self._send(body)
+            if status != SEND_SUCCESS:
+                logger.warning(f"Sending reply part {len(self.parts) + 1} failed ({status}). The rest of the reply goes out in one message.")
+                self.error = (status, payload)
+                return
+            if not self.parts:
+                metrics.put_metric('reply_first_part', round((time.perf_counter() - self._started) * 1000.0, 3))
+            self.parts.append(payload)
+        self._sent_text += self._pending[:cut]
+        self._pending = self._pending[cut:]
+
+    def remainder(self, final_body: str) -> str:
+        """The part of the final reply body that has not been sent yet (stripped)."""
+        if not final_body.startswith(self._sent_text):
+            logger.warning("Final reply body doesn't start with the streamed parts. Sending the text after them as is.")
+        return final_body[len(self._sent_text):].strip()
@@ -0,0 +1,132 @@
+# core/reply_composer.py - Messaging Lambda (WhatsApp)
+
+"""
+Outbound reply composition. A reply longer than the channel allows is split
+into parts that each fit, cutting at the last paragraph break that fits, else
+the last sentence end, else the last space (a hard cut only for a single word
+longer than the limit). Parts are packed as full as the boundaries allow, so a
+reply goes out in as few messages as possible.
+
+    parts = reply_composer.compose(body, 'whatsapp', rate_limits)
+
+Per-part limits:
+
+    whatsapp  WHATSAPP_MAX_PART_CHARS (Twilio's 1600-character body limit)
+    sms       SMS_MAX_SEGMENTS segments: 153 characters each for GSM-7 text, 67
+              for anything else (UCS-2), or a single 160 / 70 segment
+    any       the company's rate_limits.max_message_length, when lower
+
+Sending is up to the caller (twilio_service.send_whatsapp_parts sends the parts
+in order). remainder() gives the text still to send once some parts went out.
+"""
+
+import logging
+import os
+import re
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+
+WHATSAPP_MAX_PART_CHARS = int(os.environ.get('WHATSAPP_MAX_PART_CHARS', '1600'))
+SMS_MAX_SEGMENTS = int(os.environ.get('SMS_MAX_SEGMENTS', '10'))
+
+# Characters per SMS segment: (single segment, each segment of a concatenated message)
+_GSM7_SEGMENT = (160, 153)
+_UCS2_SEGMENT = (70, 67)
+# GSM 03.38 basic character set plus the extension table (extension characters take two septets)
+_GSM7_BASIC = set(
+    "@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?"
+    "¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà"
+)
+_GSM7_EXTENDED = set("^{}\\[~]|€\f")
+
+_PARAGRAPH_BREAK = re.compile(r'\n\s*\n')
+_SENTENCE_END = re.compile(r'[.!?…]["\'\)\]]*(?=\s)')
+
+
+def _is_gsm7(text: str) -> bool:
+    return all(char in _GSM7_BASIC or char in _GSM7_EXTENDED for char in text)
+
+
+def part_limit(channel: str, rate_limits: Optional[Dict[str, Any]] = None, text: str = '') -> int:
+    """Most characters one outbound message may carry on this channel (for SMS, depends on the text's encoding)."""
+    if channel == 'sms':
+        gsm7 = _is_gsm7(text)
+        single, concatenated = _GSM7_SEGMENT if gsm7 else _UCS2_SEGMENT
+        # GSM-7 extension characters take two septets
+        extended = sum(1 for char in text if char in _GSM7_EXTENDED) if gsm7 else 0
+        if len(text) + extended <= single:
+            limit = single
+        else:
+            limit = concatenated * max(SMS_MAX_SEGMENTS, 1) - extended
+    else:
+        limit = WHATSAPP_MAX_PART_CHARS
+
+    max_length = (rate_limits or {}).get('max_message_length')
+    try:
+        if max_length and int(max_length) > 0:
+            limit = min(limit, int(max_length))
+    except (TypeError, ValueError):
+        logger.warning(f"Ignoring invalid max_message_length {max_length!r}")
+    return limit
+
+
+def _cut(text: str, limit: int) -> int:
+    """Length of the prefix of `text` (longer than limit) that forms the next part."""
+    window = text[:limit + 1]
+    paragraph = None
+    for match in _PARAGRAPH_BREAK.finditer(window):
+        if 0 < match.start() <= limit:
+            paragraph = match.start()
+    if paragraph is not None:
+        return paragraph
+    sentence = None
+    for match in _SENTENCE_END.finditer(window):
+        if match.end() <= limit:
+            sentence = match.end()
+    if sentence is not None:
+        return sentence
+    space = window.rfind(' ', 1, limit + 1)
+    return space if space > 0 else limit
+
+
+def split(text: str, limit: int) -> List[str]:
+    """Splits text into stripped parts of at most `limit` characters."""
+    text = (text or '').strip()
+    if limit <= 0:
+        return [text] if text else []
+    parts = []
+    while len(text) > limit:
+        cut = _cut(text, limit)
+        part = text[:cut].strip()
+        if part:
+            parts.append(part)
+        text = text[cut:].strip()
+    if text:
+        parts.append(text)
+    return parts
+
+
+def compose(text: str, channel: str = 'whatsapp', rate_limits: Optional[Dict[str, Any]] = None) -> List[str]:
+    """The messages to send for a reply on a channel, in order."""
+    limit = part_limit(channel, rate_limits, text)
+    parts = split(text, limit)
+    if len(parts) > 1:
+        logger.info(f"Split a {len(text)}-character reply into {len(parts)} parts of at most {limit} characters.")
+    return parts
+
+
+def remainder(text: str, sent_bodies: List[str]) -> str:
+    """
+    The part of a reply not yet covered by the parts already sent, in order
+    (e.g. after a retry that found some parts delivered). Stripped, '' once all went out.
+    """
+    rest = (text or '').strip()
+    for body in sent_bodies:
+        body = (body or '').strip()
+        if not rest.startswith(body):
+            logger.warning("Reply doesn't continue with the parts already sent. Sending the rest after the matching parts.")
+            break
+        rest = rest[len(body):].strip()
+    return rest
@@ -0,0 +1,157 @@
+# core/sender_rate_limiter.py - Messaging Lambda (WhatsApp)
+"""
+Paces outbound Twilio messages per sender number, so conversations on one
+`company_whatsapp_number` that finish at the same time stay under the sender's
+throughput limit instead of running into 429s and a full SQS redelivery.
+
+The limit comes from the company's `rate_limits` config, falling back to
+DEFAULT_SENDER_MESSAGES_PER_SECOND; 0 means unlimited:
+
+    sender_messages_per_second   - messages per sender number per second
+
+The shared bucket is a DynamoDB atomic counter per sender and second, in the
+trigger-lock table (dynamodb_service.reserve_send_tokens, passed in as
+`reserve`). To avoid a round trip per message, each container reserves a small
+lease of tokens at a time and spends it from a local bucket:
+
+    pace = functools.partial(sender_rate_limiter.acquire, sender, limit, dynamodb_service.reserve_send_tokens)
+    pace()                 # True once the message may be sent
+    pace(throttled=True)   # after a 429: drop the local tokens, back off, then acquire
+
+A full bucket waits for the next second, for at most SENDER_RATE_MAX_WAIT_SECONDS
+and never past the invocation's deadline (retry_policy.remaining_seconds). If
+the wait does not fit, acquire returns False and the send takes the transient
+path. Counter failures fail open: a DynamoDB problem must not stop replies.
+"""
+
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+from ..utils import metrics
+from ..utils import retry_policy
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+
+# --- Configuration ---
+SENDER_RATE_LIMITING_ENABLED = os.environ.get('SENDER_RATE_LIMITING_ENABLED', 'true').lower() == 'true'
+DEFAULT_SENDER_MESSAGES_PER_SECOND = int(os.environ.get('DEFAULT_SENDER_MESSAGES_PER_SECOND', '0'))
+SENDER_RATE_MAX_WAIT_SECONDS = float(os.environ.get('SENDER_RATE_MAX_WAIT_SECONDS', '5'))
+# Most tokens a container reserves per DynamoDB round trip
+SENDER_RATE_LEASE_SIZE = int(os.environ.get('SENDER_RATE_LEASE_SIZE', '5'))
+# A lease never exceeds limit / divisor, so several warm containers can share the sender
+SENDER_RATE_LEASE_DIVISOR = int(os.environ.get('SENDER_RATE_LEASE_DIVISOR', '10'))
+# Local block after Twilio answers 429 (on top of waiting for the next second)
+SENDER_THROTTLE_BACKOFF_SECONDS = float(os.environ.get('SENDER_THROTTLE_BACKOFF_SECONDS', '1'))
+# Counter items outlive their second by this much before TTL removes them
+COUNTER_TTL_BUFFER_SECONDS = int(os.environ.get('SENDER_RATE_COUNTER_TTL_BUFFER_SECONDS', '300'))
+
+# sender_number -> {'second': int, 'tokens': int, 'blocked_until': epoch}
+_local_buckets = {}
+_lock = threading.Lock()
+
+
+def resolve_limit(rate_limits: Optional[Dict[str, Any]]) -> int:
+    """Messages per second allowed per sender number for the company (0 = unlimited)."""
+    value = (rate_limits or {}).get('sender_messages_per_second')
+    try:
+        return max(int(value), 0) if value is not None else DEFAULT_SENDER_MESSAGES_PER_SECOND
+    except (TypeError, ValueError):
+        logger.warning(f"Ignoring invalid sender_messages_per_second {value!r}")
+        return DEFAULT_SENDER_MESSAGES_PER_SECOND
+
+
+def _lease_size(limit: int) -> int:
+    return max(1, min(SENDER_RATE_LEASE_SIZE, limit // SENDER_RATE_LEASE_DIVISOR))
+
+
+def _reserve(sender_number: str, limit: int, second: int, reserve: Callable) -> str:
+    """
+    Reserves a lease (or a single token) on the sender's counter for this second.
+    Returns 'RESERVED', 'LIMIT_EXCEEDED' or 'ERROR'; on 'RESERVED' the spare tokens go to the local bucket.
+    """
+    counter_key = f"sendrate#{sender_number}#{second}"
+    for amount in sorted({_lease_size(limit), 1}, reverse=True):
+        status = (reserve(counter_key, amount, limit, second + 1 + COUNTER_TTL_BUFFER_SECONDS) or {}).get('status')
+        if status == 'RESERVED':
+            with _lock:
+                state = _local_buckets[sender_number]
+                if state['second'] == second:
+                    state['tokens'] += amount - 1
+            return 'RESERVED'
+        if status != 'LIMIT_EXCEEDED':
+            logger.warning(f"Sender rate counter unavailable for {sender_number} ({status}); allowing send")
+            return 'ERROR'
+    return 'LIMIT_EXCEEDED'
+
+
+def acquire(sender_number: str, limit: int, reserve: Callable, throttled: bool = False) -> bool:
+    """
+    Takes one send from the sender's rate limit, waiting for a free slot if needed.
+
+    Args:
+        sender_number: The company's sending number (the bucket key).
+        limit: Messages per second for the sender (resolve_limit); 0 means unlimited.
+        reserve: reserve(counter_key, amount, limit, expires_at) -> {'status': ...},
+                 i.e. dynamodb_service.reserve_send_tokens.
+        throttled: True when Twilio just answered 429 for this sender.
+
+    Returns:
+        bool: True if the message may be sent now, False if no slot frees up
+              within the wait budget.
+    """
+    if not SENDER_RATE_LIMITING_ENABLED or not sender_number or limit <= 0:
+        return True
+
+    budget = SENDER_RATE_MAX_WAIT_SECONDS
+    remaining = retry_policy.remaining_seconds()
+    if remaining is not None:
+        budget = min(budget, remaining)
+    started = time.monotonic()
+    slept = False
+
+    with _lock:
+        state = _local_buckets.setdefault(sender_number, {'second': None, 'tokens': 0, 'blocked_until': 0.0})
+        if throttled:
+            state['tokens'] = 0
+            state['blocked_until'] = max(state['blocked_until'], time.time() + SENDER_THROTTLE_BACKOFF_SECONDS)
+
+    while True:
+        now = time.time()
+        second = int(now)
+        with _lock:
+            if state['second'] != second:
+                state['second'] = second
+                state['tokens'] = 0
+            wait = state['blocked_until'] - now
+            if wait <= 0 and state['tokens'] > 0:
+                state['tokens'] -= 1
+                break
+
+        if wait <= 0:
+            status = _reserve(sender_number, limit, second, reserve)
+            if status != 'LIMIT_EXCEEDED':
+                break
+            with _lock:
+                state['blocked_until'] = max(state['blocked_until'], second + 1)
+            wait = second + 1 - now
+
+        if time.monotonic() - started + wait > budget:
+            logger.warning(f"Sender {sender_number} has no free send slot within {budget:.1f}s (limit {limit}/s)")
+            metrics.put_metric('sender_rate_limited', 1, metrics.UNIT_COUNT)
+            return False
+        time.sleep(wait)
+        slept = True
+
+    if slept:
+        metrics.put_metric('sender_rate_wait', (time.monotonic() - started) * 1000)
+    return True
+
+
+def reset_local_state():
+    """Clears the per-container sender buckets (tests, or after a config change)."""
+    with _lock:
+        _local_buckets.clear()
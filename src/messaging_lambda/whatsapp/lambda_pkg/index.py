@@ -5,17 +5,226 @@ import logging
 import os
 import datetime # Need datetime
 import time # Import time for duration calculation
+import math
+import random
+import functools
 
 # Import services and utils
 from .services import dynamodb_service
 from .services import secrets_manager_service # Import secrets service
 from .core import openai_service # Import AI service
+from .core import progressive_reply
+from .core import reply_composer
+from .core import sender_rate_limiter
+from .core import ai_backend
+from .core import context_window
+from .core import key_pool
+from .core import batch_service
 from .services import twilio_service # Import Twilio service
+from .services import sqs_service
+from .services import company_config_service
 from .utils.sqs_heartbeat import SQSHeartbeat # Import the heartbeat class
+from .utils import metrics
+from .utils import retry_policy
 
 logger = logging.getLogger(__name__)
 logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
 
+# Per-company concurrent-conversation cap, from rate_limits.concurrent_conversations (0 = unlimited)
+DEFAULT_CONCURRENT_CONVERSATIONS = int(os.environ.get('DEFAULT_CONCURRENT_CONVERSATIONS', '0'))
+# Records over the cap are hidden for this long (+ random jitter) instead of being failed
+CONCURRENCY_DEFER_SECONDS = int(os.environ.get('CONCURRENCY_DEFER_SECONDS', '20'))
+CONCURRENCY_DEFER_JITTER_SECONDS = int(os.environ.get('CONCURRENCY_DEFER_JITTER_SECONDS', '10'))
+# FIFO triggers that arrive before their batch deadline wait inline up to this long,
+# longer remainders are hidden until the deadline instead
+FIFO_MAX_INLINE_WAIT_SECONDS = float(os.environ.get('FIFO_MAX_INLINE_WAIT_SECONDS', '5'))
+# Requests of projects in batch mode are queued here for batch_runner (unset = batch mode off)
+BATCH_QUEUE_URL = os.environ.get('BATCH_QUEUE_URL')
+# Checkpoint each reply in a stage-table outbox, so a retry skips the AI run and parts already sent
+REPLY_OUTBOX_ENABLED = os.environ.get('REPLY_OUTBOX_ENABLED', 'true').lower() == 'true'
+# AI result fields kept in the outbox (what Steps 10-12 read)
+OUTBOX_AI_FIELDS = ('response_content', 'prompt_tokens', 'completion_tokens', 'total_tokens')
+
+def _concurrency_limit(conversation_item):
+    """Returns the company's concurrent-conversation cap for this conversation (0 = unlimited)."""
+    rate_limits = conversation_item.get('rate_limits') or {}
+    try:
+        return max(int(rate_limits.get('concurrent_conversations') or DEFAULT_CONCURRENT_CONVERSATIONS), 0)
+    except (TypeError, ValueError):
+        return DEFAULT_CONCURRENT_CONVERSATIONS
+
+def _hydrate_conversation(primary_channel, conversation_id):
+    """
+    Reads the conversation item. With a company-data table configured, only the
+    per-conversation fields are read and the company config is overlaid from
+    company_config_service; if the company has no usable record the whole item is read.
+    """
+    if not company_config_service.is_enabled():
+        return dynamodb_service.get_conversation_item(primary_channel, conversation_id)
+
+    item = dynamodb_service.get_conversation_item(primary_channel, conversation_id, attributes=dynamodb_service.CONVERSATION_FIELDS)
+    if item is None:
+        return None
+    config_status, company_config = company_config_service.get_company_config(item.get('company_id'), item.get('project_id'))
+    if config_status != company_config_service.CONFIG_FOUND:
+        logger.warning(f"No company config for {item.get('company_id')}/{item.get('project_id')} ({config_status}). Reading the full conversation item.")
+        return dynamodb_service.get_conversation_item(primary_channel, conversation_id)
+    item.update(company_config_service.channel_view(company_config, item.get('channel_method') or 'whatsapp'))
+    return item
+
+def _conversation_history(primary_channel, conversation_id, conversation_item):
+    """
+    The conversation's stored messages (oldest first). A projected read
+    (company config enabled) doesn't include them, so they are read separately.
+    """
+    if 'messages' in conversation_item:
+        return conversation_item.get('messages') or []
+    item = dynamodb_service.get_conversation_item(primary_channel, conversation_id, attributes=('messages',))
+    if item is None:
+        raise Exception(f"Transient error reading message history for {conversation_id}")
+    return item.get('messages') or []
+
+def _compact_context(primary_channel, conversation_id, window, history, new_messages, api_key):
+    """
+    Extends the rolling summary once enough history has piled up behind it
+    (summarize strategy). Runs after the reply is stored; failures only log.
+    """
+    if history is None:
+        item = dynamodb_service.get_conversation_item(primary_channel, conversation_id, attributes=('messages',))
+        if item is None:
+            logger.warning(f"Could not read history of {conversation_id} for context compaction.")
+            return
+        history = item.get('messages') or []
+    else:
+        history = list(history) + new_messages
+    if not context_window.needs_compaction(window, len(history)):
+        return
+    new_state = context_window.compact(window, history, api_key)
+    if new_state is not None:
+        dynamodb_service.update_context_window(primary_channel, conversation_id, new_state, window['covers'])
+
+def _pending_batch_fragments(primary_channel, conversation_id):
+    """
+    For a reprocess trigger whose staged fragments have expired: the pending
+    batch request on the conversation item, as a single fragment ([] if none).
+    """
+    item = dynamodb_service.get_conversation_item(primary_channel, conversation_id, attributes=('conversation_id', 'batch_request'))
+    pending = (item or {}).get('batch_request')
+    if not pending or not pending.get('combined_body') or not pending.get('first_message_sid'):
+        return []
+    return [{
+        'conversation_id': conversation_id,
+        'message_sid': pending['first_message_sid'],
+        'primary_channel': primary_channel,
+        'body': pending['combined_body'],
+        'received_at': pending.get('queued_at', ' ')
+    }]
+
+def _reply_body(raw_reply_content):
+    """The reply text from the assistant's JSON answer ({"content": ...}), or None if it can't be extracted."""
+    if not raw_reply_content:
+        logger.error("Missing AI response content ('response_content') in context object.")
+        return None
+    try:
+        parsed_response = json.loads(raw_reply_content)
+        if isinstance(parsed_response, dict) and 'content' in parsed_response:
+            logger.info("Successfully parsed AI response and extracted content.")
+            logger.debug(f"Extracted final reply body: {parsed_response['content'][:200]}...")
+            return parsed_response['content']
+        logger.error(f"Parsed AI response is not a dict or missing 'content' key. Raw: {raw_reply_content[:500]}")
+    except json.JSONDecodeError as e:
+        logger.error(f"Failed to parse AI response as JSON: {e}. Raw: {raw_reply_content[:500]}")
+    except Exception as e:
+        logger.exception(f"Unexpected error parsing AI response: {e}. Raw: {raw_reply_content[:500]}")
+    return None
+
+def _sender_pace(sender_number, rate_limits=None):
+    """
+    Twilio send kwargs that pace messages under the sender number's rate limit
+    (core/sender_rate_limiter.py), or {} if the company sets no limit.
+    """
+    limit = sender_rate_limiter.resolve_limit(rate_limits)
+    if not limit or not sender_number:
+        return {}
+    return {'pace': functools.partial(sender_rate_limiter.acquire, sender_number, limit,
+                                      dynamodb_service.reserve_send_tokens)}
+
+def _send_reply(twilio_creds, recipient_number, sender_number, body, rate_limits=None):
+    """
+    Sends a reply via Twilio, split into parts that fit the channel (core/reply_composer.py)
+    and paced under the sender's rate limit.
+    Returns (status, payload) like twilio_service.send_whatsapp_reply; a reply sent in
+    several parts also lists their 'message_sids'.
+    """
+    parts = reply_composer.compose(body, 'whatsapp', rate_limits)
+    pace = _sender_pace(sender_number, rate_limits)
+    if len(parts) <= 1:
+        return twilio_service.send_whatsapp_reply(
+            twilio_creds=twilio_creds,
+            recipient_number=recipient_number,
+            sender_number=sender_number,
+            message_body=body,
+            **pace
+        )
+    metrics.put_metric('reply_split_parts', len(parts), metrics.UNIT_COUNT)
+    status, payload = twilio_service.send_whatsapp_parts(twilio_creds, recipient_number, sender_number, parts, **pace)
+    if status != twilio_service.TWILIO_SUCCESS and (payload or {}).get('sent'):
+        logger.warning(f"{len(payload['sent'])} of {len(parts)} reply parts were sent before the failure.")
+    return status, payload
+
+def _split_outboxes(staged_items):
+    """Separates reply outbox records (dynamodb_service.save_reply_outbox) from the message fragments."""
+    fragments = [item for item in staged_items if not dynamodb_service.is_outbox_item(item)]
+    outboxes = [item for item in staged_items if dynamodb_service.is_outbox_item(item)]
+    return fragments, outboxes
+
+def _resumable_outbox(staged_items, outboxes):
+    """
+    The outbox record a retried trigger resumes, or None to answer the staged
+    fragments afresh. A reply that went out (in full or in part) is always
+    finished; one that sent nothing is only reused while no new fragments arrived.
+    """
+    for outbox in sorted(outboxes, key=lambda o: (o.get('created_at', 0), o.get('message_sid'))):
+        covered = set(outbox.get('message_sids') or [])
+        if (outbox.get('stage') == dynamodb_service.OUTBOX_SENT or outbox.get('sent')
+                or all(item.get('message_sid') in covered for item in staged_items)):
+            return outbox
+    return None
+
+def _sent_part(payload):
+    """The outbox copy of a delivered part's send payload."""
+    return {'message_sid': payload['message_sid'], 'body': payload.get('body') or ''}
+
+
+def _fragment_received_ms(item):
+    """Returns a staged fragment's arrival time in epoch ms, or None if unknown."""
+    received_at_ms = item.get('received_at_ms')
+    if received_at_ms is not None:
+        return int(received_at_ms)
+    received_at = item.get('received_at')
+    if not received_at:
+        return None
+    try:
+        return int(datetime.datetime.fromisoformat(received_at).timestamp() * 1000)
+    except (TypeError, ValueError):
+        return None
+
+def _summarize_batch_timing(staged_items):
+    """
+    Builds the batch timing counters recorded on the trigger-lock item for the
+    adaptive batch window: fragment count and the gaps between fragments.
+    """
+    arrivals = sorted(ms for ms in (_fragment_received_ms(item) for item in staged_items) if ms is not None)
+    gaps = [later - earlier for earlier, later in zip(arrivals, arrivals[1:])]
+    return {
+        'fragment_count': len(staged_items),
+        'gap_sum_ms': sum(gaps),
+        'gap_count': len(gaps),
+        'last_fragment_at_ms': arrivals[-1] if arrivals else 0
+    }
+
+@metrics.flush_after_invocation
+@retry_policy.per_invocation
 def handler(event, context):
     logger.info("WhatsApp Messaging Lambda triggered")
     logger.debug(f"Received event: {json.dumps(event)}")
@@ -46,6 +255,10 @@ def handler(event, context):
 
     # List to track failed message identifiers for SQS partial batch response
     batch_item_failures = []
+    # FIFO queue: once a record fails, later records of its message group must not
+    # be processed (or deleted) ahead of it
+    fifo_queue = sqs_service.is_fifo_queue(whatsapp_queue_url)
+    failed_message_groups = set()
 
     for record in event.get('Records', []):
         message_id = record.get('messageId', 'unknown')
@@ -55,11 +268,21 @@ def handler(event, context):
         heartbeat = None   # Initialize heartbeat object reference
         primary_channel = None # Keep track for finally block
         conversation_id = None # Keep track for finally block
+        concurrency_slot = None # (company_id, project_id) while a concurrency slot is held
+        deferred = False # Over the company's concurrency cap - put back on the queue
         processing_start_time = time.time() # Capture start time
+        record_timer_start = time.perf_counter() # Monotonic, for the record_total metric
+        metrics.begin_scope(channel='whatsapp')
+        message_group_id = record.get('attributes', {}).get('MessageGroupId')
 
         try:
             logger.info(f"Processing message ID: {message_id}")
 
+            if message_group_id and message_group_id in failed_message_groups:
+                logger.warning(f"An earlier record of message group {message_group_id} failed in this batch. Failing message {message_id} to keep the group in order.")
+                batch_item_failures.append({"itemIdentifier": message_id})
+                continue
+
             # 1. Parse SQS message and store in context
             body_str = record.get('body')
             if not body_str:
@@ -82,9 +305,28 @@ def handler(event, context):
                 batch_item_failures.append({"itemIdentifier": message_id})
                 continue
             logger.info(f"Extracted from SQS: conversation_id={conversation_id}, primary_channel={primary_channel} for message {message_id}")
+            # Sent by batch_runner for conversations stuck in 'retry' (core/batch_service.py)
+            reprocess = bool(context_object['sqs_data'].get('reprocess'))
+
+            # 1b. FIFO triggers have no per-message delay - wait out the rest of the batch window
+            batch_deadline_ms = context_object['sqs_data'].get('batch_deadline_ms')
+            if fifo_queue and batch_deadline_ms:
+                remaining_seconds = (int(batch_deadline_ms) - time.time() * 1000) / 1000.0
+                if 0 < remaining_seconds <= FIFO_MAX_INLINE_WAIT_SECONDS:
+                    logger.info(f"Batch window for {conversation_id} closes in {remaining_seconds:.2f}s. Waiting before merging.")
+                    time.sleep(remaining_seconds)
+                elif remaining_seconds > FIFO_MAX_INLINE_WAIT_SECONDS:
+                    logger.info(f"Batch window for {conversation_id} closes in {remaining_seconds:.2f}s. Deferring message {message_id} until then.")
+                    deferred = True
+                    receive_count = int(record.get('attributes', {}).get('ApproximateReceiveCount', '1'))
+                    defer_status = sqs_service.defer_message(whatsapp_queue_url, receipt_handle, body_str, receive_count, math.ceil(remaining_seconds))
+                    if defer_status != sqs_service.SQS_REQUEUED:
+                        batch_item_failures.append({"itemIdentifier": message_id})
+                    continue
 
             # 2. Acquire Processing Lock
-            lock_status = dynamodb_service.acquire_processing_lock(primary_channel, conversation_id)
+            with metrics.timer('processing_lock'):
+                lock_status = dynamodb_service.acquire_processing_lock(primary_channel, conversation_id)
             if lock_status == dynamodb_service.LOCK_EXISTS:
                 logger.warning(f"Processing lock already held for {primary_channel}/{conversation_id}. Skipping message {message_id}.")
                 continue
@@ -117,7 +359,8 @@ def handler(event, context):
 
             # --- Step 3: Query Staging Table --- #
             logger.info(f"Querying staging table for conversation {conversation_id}...")
-            staged_items = dynamodb_service.query_staging_table(conversation_id)
+            with metrics.timer('stage_query'):
+                staged_items = dynamodb_service.query_staging_table(conversation_id)
 
             if staged_items is None:
                 # Indicates a DB error occurred during the query
@@ -126,8 +369,22 @@ def handler(event, context):
                 batch_item_failures.append({"itemIdentifier": message_id})
                 continue # Move to next record
 
+            # A reply checkpointed by an earlier attempt (Step 9c) is resumed, not regenerated
+            staged_items, outboxes = _split_outboxes(staged_items)
+            outbox = _resumable_outbox(staged_items, outboxes) if REPLY_OUTBOX_ENABLED else None
+            leftover_items = []
+            if outbox is not None:
+                # Fragments that arrived after the outbox's reply get a trigger of their own (Step 13)
+                covered = set(outbox.get('message_sids') or [])
+                leftover_items = [item for item in staged_items if item.get('message_sid') not in covered]
+                staged_items = [item for item in staged_items if item.get('message_sid') in covered]
+                logger.info(f"Resuming the reply to {outbox.get('first_message_sid')} for {conversation_id} from its outbox (stage {outbox.get('stage')}).")
+                metrics.put_metric('reply_outbox_resumed', 1, metrics.UNIT_COUNT)
+
             # --- Step 4: Handle Empty Batch --- #
-            if not staged_items:
+            if not staged_items and outbox is None and reprocess:
+                staged_items = _pending_batch_fragments(primary_channel, conversation_id)
+            if not staged_items and outbox is None:
                 logger.warning(f"No items found in staging table for conversation {conversation_id} (message {message_id}). Might be a late trigger or cleanup issue. Releasing lock and skipping.")
                 # No need to release lock here, finally block handles it
                 # We consider this successful processing of the *trigger message* itself
@@ -142,17 +399,25 @@ def handler(event, context):
                 batch_item_failures.append({"itemIdentifier": message_id})
                 continue
 
-            # Concatenate the 'body' attributes
-            combined_body = "\n".join(item.get('body', '') for item in staged_items)
-            logger.info(f"Merged {len(staged_items)} fragments for conversation {conversation_id}. Total length: {len(combined_body)}")
-            logger.debug(f"Combined body for {conversation_id}: {combined_body[:500]}...") # Log snippet
+            if outbox is not None:
+                # The outbox holds the batch as it was answered (its fragments may have expired)
+                combined_body = outbox.get('combined_body', '')
+                extracted_primary_channel = outbox.get('primary_channel')
+                first_message_sid = outbox.get('first_message_sid')
+                message_sids = list(outbox.get('message_sids') or [first_message_sid])
+            else:
+                # Concatenate the 'body' attributes
+                combined_body = "\n".join(item.get('body', '') for item in staged_items)
+                logger.info(f"Merged {len(staged_items)} fragments for conversation {conversation_id}. Total length: {len(combined_body)}")
+                logger.debug(f"Combined body for {conversation_id}: {combined_body[:500]}...") # Log snippet
 
-            # Extract primary_channel from the *first* staged item (should be consistent across items)
-            # This is needed for the GetItem call in the next step
-            extracted_primary_channel = staged_items[0].get('primary_channel')
-            # --- ADDED: Extract message_sid of the first message --- #
-            first_message_sid = staged_items[0].get('message_sid')
-            # --- END ADDED --- #
+                # Extract primary_channel from the *first* staged item (should be consistent across items)
+                # This is needed for the GetItem call in the next step
+                extracted_primary_channel = staged_items[0].get('primary_channel')
+                # --- ADDED: Extract message_sid of the first message --- #
+                first_message_sid = staged_items[0].get('message_sid')
+                # --- END ADDED --- #
+                message_sids = [item.get('message_sid') for item in staged_items]
             # --- ADDED: Consistency check --- #
             if primary_channel != extracted_primary_channel:
                  logger.error(f"Mismatch between SQS primary_channel ({primary_channel}) and staging table primary_channel ({extracted_primary_channel}) for {conversation_id}. Failing.")
@@ -175,7 +440,8 @@ def handler(event, context):
             # --- Step 6: Hydrate Canonical Conversation Row --- #
             logger.info(f"Hydrating conversation context for {conversation_id} using PK={primary_channel}...")
             # Overwrite context_object with the full record from DB
-            context_object['conversations_db_data'] = dynamodb_service.get_conversation_item(primary_channel, conversation_id)
+            with metrics.timer('hydration'):
+                context_object['conversations_db_data'] = _hydrate_conversation(primary_channel, conversation_id)
 
             if context_object['conversations_db_data'] is None:
                 logger.error(f"Failed to hydrate conversation context for {conversation_id} (PK={primary_channel}). Cannot proceed. Failing message {message_id}.")
@@ -184,8 +450,50 @@ def handler(event, context):
                 continue # Move to next record
 
             logger.info(f"Successfully hydrated conversation context for {conversation_id}.")
+            metrics.set_dimensions(company_id=context_object['conversations_db_data'].get('company_id'))
             # context_object now holds the main conversation record's data
 
+            # --- Step 6b: Fold In a Superseded Batch Request --- #
+            # A reply still waiting on a batch is answered together with the new messages
+            # (its batch result is discarded); its text is kept here once its fragments expired
+            # (a resumed outbox already includes it)
+            pending_batch = context_object['conversations_db_data'].get('batch_request')
+            if outbox is None and pending_batch and pending_batch.get('first_message_sid') not in message_sids:
+                logger.info(f"Including pending batch request {pending_batch.get('custom_id')} in the reply for {conversation_id}.")
+                combined_body = f"{pending_batch['combined_body']}\n{combined_body}"
+                first_message_sid = pending_batch['first_message_sid']
+                message_sids = list(pending_batch.get('message_sids') or [first_message_sid]) + message_sids
+                context_object['staging_table_merged_data'] = {
+                    'combined_body': combined_body,
+                    'first_message_sid': first_message_sid
+                }
+
+            # --- Step 7: Per-company Concurrency Slot --- #
+            hydrated_item = context_object['conversations_db_data']
+            company_id = hydrated_item.get('company_id')
+            project_id = hydrated_item.get('project_id')
+            concurrency_limit = _concurrency_limit(hydrated_item)
+            if concurrency_limit and company_id and project_id:
+                with metrics.timer('concurrency_slot'):
+                    slot_status = dynamodb_service.acquire_concurrency_slot(company_id, project_id, conversation_id, concurrency_limit)
+                if slot_status == dynamodb_service.SEMAPHORE_ACQUIRED:
+                    concurrency_slot = (company_id, project_id)
+                elif slot_status == dynamodb_service.SEMAPHORE_FULL:
+                    logger.warning(f"{company_id}/{project_id} is at its limit of {concurrency_limit} concurrent conversations. Deferring message {message_id}.")
+                    deferred = True
+                    if heartbeat:
+                        heartbeat.stop()
+                    receive_count = int(record.get('attributes', {}).get('ApproximateReceiveCount', '1'))
+                    defer_seconds = CONCURRENCY_DEFER_SECONDS + random.randint(0, CONCURRENCY_DEFER_JITTER_SECONDS)
+                    defer_status = sqs_service.defer_message(whatsapp_queue_url, receipt_handle, body_str, receive_count, defer_seconds)
+                    if defer_status != sqs_service.SQS_REQUEUED:
+                        # Keep the original on the queue; it reappears after the new visibility timeout
+                        batch_item_failures.append({"itemIdentifier": message_id})
+                    continue
+                else:
+                    # Don't block replies on the semaphore itself
+                    logger.warning(f"Concurrency semaphore unavailable for {company_id}/{project_id}. Processing {message_id} without a slot.")
+
             # --- Step 8: Fetch Secrets --- #
             logger.info(f"Fetching secrets for conversation {conversation_id}...")
             context_object['secrets'] = {} # Initialize secrets dict
@@ -205,7 +513,8 @@ def handler(event, context):
                 fetch_error_status = secrets_manager_service.SECRET_INVALID_INPUT # Treat missing ref as permanent error
                 error_details = "Missing OpenAI secret reference"
             else:
-                openai_status, openai_secret = secrets_manager_service.get_secret(openai_secret_ref)
+                with metrics.timer('secrets'):
+                    openai_status, openai_secret = secrets_manager_service.get_secret(openai_secret_ref)
                 if openai_status == secrets_manager_service.SECRET_SUCCESS:
                     context_object['secrets']['openai'] = openai_secret
                     logger.info(f"Successfully fetched OpenAI secret ({openai_secret_ref})")
@@ -225,7 +534,8 @@ def handler(event, context):
                     fetch_error_status = secrets_manager_service.SECRET_INVALID_INPUT
                     error_details = "Missing Twilio secret reference"
                 else:
-                    twilio_status, twilio_secret = secrets_manager_service.get_secret(twilio_secret_ref)
+                    with metrics.timer('secrets'):
+                        twilio_status, twilio_secret = secrets_manager_service.get_secret(twilio_secret_ref)
                     if twilio_status == secrets_manager_service.SECRET_SUCCESS:
                         context_object['secrets']['twilio'] = twilio_secret
                         logger.info(f"Successfully fetched Twilio secret ({twilio_secret_ref})")
@@ -260,10 +570,13 @@ def handler(event, context):
             ai_input_assistant_id = ai_config.get('assistant_id_replies')
             ai_input_user_message = context_object.get('staging_table_merged_data', {}).get('combined_body')
             openai_creds = context_object.get('secrets', {}).get('openai')
-            ai_input_api_key = openai_creds.get('ai_api_key') if openai_creds else None
+            ai_api_keys = key_pool.api_keys(openai_creds)
+
+            backend = ai_backend.backend_for(ai_config)
+            window = context_window.plan(ai_config, db_data)
 
             # Validate required AI inputs
-            if not ai_input_thread_id:
+            if not ai_input_thread_id and backend == ai_backend.BACKEND_THREADS:
                 logger.error(f"Missing required openai_thread_id for conversation {conversation_id}. Cannot proceed with AI reply.")
                 batch_item_failures.append({"itemIdentifier": message_id})
                 continue
@@ -275,18 +588,124 @@ def handler(event, context):
                 logger.error(f"Missing combined_body for AI input for conversation {conversation_id}. Cannot proceed.")
                 batch_item_failures.append({"itemIdentifier": message_id})
                 continue
-            if not ai_input_api_key:
+            if not ai_api_keys:
                 logger.error(f"Missing OpenAI API key after secret fetch for conversation {conversation_id}. Cannot proceed.")
                 batch_item_failures.append({"itemIdentifier": message_id})
                 continue
 
-            # Call the AI service function
-            ai_status, ai_result_payload = openai_service.process_reply_with_ai(
-                thread_id=ai_input_thread_id,
-                assistant_id=ai_input_assistant_id,
-                user_message_content=ai_input_user_message,
-                api_key=ai_input_api_key
-            )
+            # Progressive mode: stream the run and send complete sentences / paragraphs while it generates
+            progressive = None
+            twilio_creds = context_object.get('secrets', {}).get('twilio')
+            sender_num = channel_config.get('company_whatsapp_number')
+            if outbox is None and progressive_reply.is_enabled(ai_config) and twilio_creds and sender_num:
+                progressive = progressive_reply.ProgressiveReply(
+                    functools.partial(twilio_service.send_whatsapp_reply, twilio_creds, primary_channel, sender_num,
+                                      **_sender_pace(sender_num, db_data.get('rate_limits'))),
+                    max_part_chars=min(progressive_reply.PROGRESSIVE_MAX_PART_CHARS,
+                                       reply_composer.part_limit('whatsapp', db_data.get('rate_limits')))
+                )
+
+            # Single-request backends build the prompt from the stored history
+            history = None
+            if outbox is None and ai_backend.needs_history(backend):
+                history = _conversation_history(primary_channel, conversation_id, db_data)
+
+            # --- Step 9b: Batch Mode --- #
+            # The request waits for the next OpenAI batch; batch_runner.py delivers the reply
+            if outbox is None and BATCH_QUEUE_URL and batch_service.use_batch(ai_config, backend, reprocess):
+                with key_pool.lease(ai_api_keys) as ai_input_api_key:
+                    if ai_input_api_key is None:
+                        raise Exception("Transient AI Error: every OpenAI API key is rate limited")
+                    build_status, batch_body = batch_service.build_request(
+                        ai_input_assistant_id, ai_input_user_message, ai_input_api_key, history=history, window=window
+                    )
+                if build_status == openai_service.AI_TRANSIENT_ERROR:
+                    raise Exception(f"Transient AI Error: {batch_body.get('error_message')}")
+                elif build_status != openai_service.AI_SUCCESS:
+                    logger.error(f"Could not build batch request for {conversation_id} ({build_status}): {batch_body.get('error_message')}. Failing message {message_id}.")
+                    batch_item_failures.append({"itemIdentifier": message_id})
+                    continue
+
+                custom_id = batch_service.new_custom_id(conversation_id)
+                park_status, park_error = dynamodb_service.park_for_batch(primary_channel, conversation_id, {
+                    'custom_id': custom_id,
+                    'combined_body': ai_input_user_message,
+                    'first_message_sid': context_object['staging_table_merged_data']['first_message_sid'],
+                    'message_sids': message_sids,
+                    'queued_at': datetime.datetime.now(datetime.timezone.utc).isoformat()
+                })
+                if park_status == dynamodb_service.DB_LOCK_LOST:
+                    logger.warning(f"Lock lost before {conversation_id} could wait on a batch: {park_error}. Skipping message {message_id}.")
+                    continue
+                elif park_status != dynamodb_service.DB_SUCCESS:
+                    raise Exception(f"Transient DB Error parking {conversation_id} for batch: {park_error}")
+
+                send_status = sqs_service.send_message(BATCH_QUEUE_URL, {
+                    'custom_id': custom_id,
+                    'primary_channel': primary_channel,
+                    'conversation_id': conversation_id,
+                    'api_key_reference': openai_secret_ref,
+                    'body': batch_body
+                }, group_id=conversation_id, deduplication_id=custom_id)
+                if send_status != sqs_service.SQS_SENT:
+                    # The finally block sets the conversation to 'retry'
+                    raise Exception(f"Transient Batch Queue Error: could not queue batch request for {conversation_id}")
+
+                # New messages start a new trigger, which supersedes the queued request
+                if not fifo_queue and not dynamodb_service.cleanup_trigger_lock(
+                        conversation_id, batch_stats=_summarize_batch_timing(staged_items)):
+                    logger.warning(f"Cleanup of trigger lock failed for {conversation_id}. TTL will handle.")
+                metrics.put_metric('reply_batched', 1, metrics.UNIT_COUNT)
+                logger.info(f"Queued batch request {custom_id} for conversation {conversation_id}.")
+                continue
+
+            if outbox is not None:
+                # The AI already answered in an earlier attempt - its result is in the outbox
+                ai_status = openai_service.AI_SUCCESS
+                stored_response = outbox.get('ai_response') or {}
+                ai_result_payload = {field: stored_response.get(field) for field in OUTBOX_AI_FIELDS}
+                ai_input_api_key = ai_api_keys[0]
+            else:
+                # Call the AI service function with a key from the project's pool (core/key_pool.py)
+                with key_pool.lease(ai_api_keys) as ai_input_api_key:
+                    if ai_input_api_key is None:
+                        logger.warning(f"Every OpenAI API key for conversation {conversation_id} is rate limited. Raising exception for retry.")
+                        raise Exception("Transient AI Error: every OpenAI API key is rate limited")
+                    with metrics.timer('ai_total'):
+                        if backend != ai_backend.BACKEND_THREADS:
+                            ai_status, ai_result_payload = ai_backend.generate_reply(
+                                backend,
+                                thread_id=ai_input_thread_id,
+                                assistant_id=ai_input_assistant_id,
+                                user_message_content=ai_input_user_message,
+                                api_key=ai_input_api_key,
+                                history=history,
+                                on_text=progressive.feed if progressive is not None else None,
+                                window=window
+                            )
+                        elif progressive is not None:
+                            ai_status, ai_result_payload = openai_service.stream_reply_with_ai(
+                                thread_id=ai_input_thread_id,
+                                assistant_id=ai_input_assistant_id,
+                                user_message_content=ai_input_user_message,
+                                api_key=ai_input_api_key,
+                                on_text=progressive.feed,
+                                run_options=context_window.run_options(window)
+                            )
+                        else:
+                            ai_status, ai_result_payload = openai_service.process_reply_with_ai(
+                                thread_id=ai_input_thread_id,
+                                assistant_id=ai_input_assistant_id,
+                                user_message_content=ai_input_user_message,
+                                api_key=ai_input_api_key,
+                                run_options=context_window.run_options(window)
+                            )
+            if outbox is not None:
+                sent_parts = list(outbox.get('sent') or [])
+            else:
+                sent_parts = progressive.parts if progressive is not None else []
+            if sent_parts and ai_status != openai_service.AI_SUCCESS:
+                logger.warning(f"AI run failed after {len(sent_parts)} reply part(s) were sent for {conversation_id}. A retry sends the reply again in full.")
 
             # Handle AI processing results
             if ai_status == openai_service.AI_SUCCESS:
@@ -310,31 +729,13 @@ def handler(event, context):
             logger.info(f"Sending reply via Twilio for conversation {conversation_id}...")
 
             # Extract necessary inputs for Twilio service
-            twilio_creds = context_object.get('secrets', {}).get('twilio')
             recipient_num = primary_channel # Already extracted
-            sender_num = channel_config.get('company_whatsapp_number')
             
             # Get the raw response string from AI
             raw_reply_content = context_object.get('open_ai_response', {}).get('response_content')
 
-            # --- ADDED: Parse JSON and Extract Content --- #
-            final_reply_body = None
-            if raw_reply_content:
-                try:
-                    parsed_response = json.loads(raw_reply_content)
-                    if isinstance(parsed_response, dict) and 'content' in parsed_response:
-                        final_reply_body = parsed_response['content']
-                        logger.info("Successfully parsed AI response and extracted content.")
-                        logger.debug(f"Extracted final reply body: {final_reply_body[:200]}...")
-                    else:
-                        logger.error(f"Parsed AI response is not a dict or missing 'content' key. Raw: {raw_reply_content[:500]}")
-                except json.JSONDecodeError as e:
-                    logger.error(f"Failed to parse AI response as JSON: {e}. Raw: {raw_reply_content[:500]}")
-                except Exception as e:
-                    logger.exception(f"Unexpected error parsing AI response: {e}. Raw: {raw_reply_content[:500]}")
-            else:
-                 logger.error("Missing AI response content ('response_content') in context object.")
-            # --- END ADDED --- #
+            # Parse JSON and Extract Content
+            final_reply_body = _reply_body(raw_reply_content)
 
             # Validate required Twilio inputs
             if not twilio_creds or 'twilio_account_sid' not in twilio_creds or 'twilio_auth_token' not in twilio_creds:
@@ -352,19 +753,73 @@ def handler(event, context):
                  continue
             # recipient_num (primary_channel) was validated earlier
 
-            # Call the Twilio service function
-            # --- MODIFIED: Use final_reply_body --- #
-            twilio_status, twilio_result_payload = twilio_service.send_whatsapp_reply(
-                twilio_creds=twilio_creds,
-                recipient_number=recipient_num,
-                sender_number=sender_num,
-                message_body=final_reply_body
-            )
+            # --- Step 9c: Checkpoint the Reply in the Outbox --- #
+            # From here on a retry reuses this AI result and skips the parts already sent
+            outbox_record = None
+            # True once the outbox says the reply went out, so a failed final update can be retried
+            outbox_sent = outbox is not None and outbox.get('stage') == dynamodb_service.OUTBOX_SENT
+            if REPLY_OUTBOX_ENABLED:
+                outbox_record = dict(outbox) if outbox is not None else {
+                    'primary_channel': primary_channel,
+                    'combined_body': combined_body,
+                    'message_sids': message_sids,
+                    'stage': dynamodb_service.OUTBOX_AI_COMPLETE,
+                    'ai_response': {field: ai_result_payload.get(field) for field in OUTBOX_AI_FIELDS},
+                    'sent': [_sent_part(part) for part in sent_parts],
+                    'created_at': int(time.time())
+                }
+                if outbox is None and not dynamodb_service.save_reply_outbox(conversation_id, first_message_sid, outbox_record):
+                    logger.warning(f"Could not checkpoint the reply for {conversation_id}. A retry runs the AI again.")
+
+            if outbox_sent:
+                # Delivered by an earlier attempt - only the final update is left
+                logger.info(f"Reply for {conversation_id} was already sent ({outbox['twilio_response'].get('message_sid')}). Not sending it again.")
+                reply_body_to_send = ''
+            elif outbox is not None and sent_parts:
+                logger.info(f"{len(sent_parts)} reply part(s) for {conversation_id} were already sent. Sending the rest.")
+                reply_body_to_send = reply_composer.remainder(final_reply_body, [part.get('body') for part in sent_parts])
+            else:
+                # Parts already delivered progressively are not sent again
+                reply_body_to_send = progressive.remainder(final_reply_body) if sent_parts else final_reply_body
+
+            # Call the Twilio service function (over-length replies go out in several parts)
+            if reply_body_to_send:
+                with metrics.timer('twilio_send'):
+                    twilio_status, twilio_result_payload = _send_reply(
+                        twilio_creds, recipient_num, sender_num, reply_body_to_send, db_data.get('rate_limits')
+                    )
+            else:
+                twilio_status, twilio_result_payload = twilio_service.TWILIO_SUCCESS, None
+
+            # Parts delivered before a failure are recorded, so the retry sends only the rest
+            if twilio_status != twilio_service.TWILIO_SUCCESS and outbox_record is not None and (twilio_result_payload or {}).get('sent'):
+                outbox_record = dict(outbox_record, sent=list(outbox_record.get('sent') or []) + [_sent_part(part) for part in twilio_result_payload['sent']])
+                if not dynamodb_service.save_reply_outbox(conversation_id, first_message_sid, outbox_record):
+                    logger.warning(f"Could not record the reply parts sent for {conversation_id}. A retry sends them again.")
 
             # Handle Twilio processing results
             if twilio_status == twilio_service.TWILIO_SUCCESS:
-                context_object['twilio_response'] = twilio_result_payload
+                if outbox is not None and outbox.get('twilio_response'):
+                    context_object['twilio_response'] = outbox['twilio_response']
+                elif sent_parts or 'message_sids' in (twilio_result_payload or {}):
+                    reply_sids = [part['message_sid'] for part in sent_parts]
+                    if twilio_result_payload:
+                        reply_sids += twilio_result_payload.get('message_sids') or [twilio_result_payload['message_sid']]
+                    metrics.put_metric('reply_parts', len(reply_sids), metrics.UNIT_COUNT)
+                    # History holds the full reply, keyed by its first message
+                    context_object['twilio_response'] = {
+                        'message_sid': reply_sids[0],
+                        'body': final_reply_body,
+                        'message_sids': reply_sids
+                    }
+                else:
+                    context_object['twilio_response'] = twilio_result_payload
                 logger.info(f"Successfully sent Twilio reply for {conversation_id}.") # Simplified log
+                if outbox_record is not None and not outbox_sent:
+                    outbox_record = dict(outbox_record, stage=dynamodb_service.OUTBOX_SENT, twilio_response=context_object['twilio_response'])
+                    outbox_sent = dynamodb_service.save_reply_outbox(conversation_id, first_message_sid, outbox_record)
+                    if not outbox_sent:
+                        logger.warning(f"Could not mark the reply for {conversation_id} as sent in its outbox.")
             elif twilio_status == twilio_service.TWILIO_TRANSIENT_ERROR:
                 error_msg = twilio_result_payload.get("error_message", "Unknown transient Twilio error") if twilio_result_payload else "Unknown transient Twilio error"
                 logger.warning(f"Twilio send failed with transient error for {conversation_id}: {error_msg}. Raising exception for retry.")
@@ -402,6 +857,8 @@ def handler(event, context):
                     "completion_tokens": context_object['open_ai_response']['completion_tokens'],
                     "total_tokens": context_object['open_ai_response']['total_tokens']
                 }
+                if 'message_sids' in context_object['twilio_response']:
+                    assistant_message_map['message_sids'] = context_object['twilio_response']['message_sids']
                 logger.debug(f"User message map (ts: {user_msg_ts}): {user_message_map}")
                 logger.debug(f"Assistant message map (ts: {assistant_msg_ts}): {assistant_message_map}")
             except KeyError as ke:
@@ -427,20 +884,30 @@ def handler(event, context):
             processing_duration_ms = int((processing_end_time - processing_start_time) * 1000)
             logger.debug(f"Total processing time for record {message_id}: {processing_duration_ms} ms")
 
+            # A reply that answered a pending batch request removes it
+            update_kwargs = {'clear_batch_request': True} if pending_batch else {}
+            # A reply whose prompt reached the token budget starts limiting the context
+            activated_window = context_window.activation(window, assistant_message_map.get('prompt_tokens'))
+            if activated_window is not None:
+                update_kwargs['context_window'] = activated_window
+                window = dict(window, active=True, covers=0, summary=None)
+
             # --- Step 12: Final Atomic Update --- #
             logger.info(f"Performing final atomic update for conversation {conversation_id}.")
-            update_status, update_error_msg = dynamodb_service.update_conversation_after_reply(
-                primary_channel_pk=primary_channel,
-                conversation_id_sk=conversation_id,
-                user_message_map=user_message_map,
-                assistant_message_map=assistant_message_map,
-                new_status="reply_sent", # TODO: Make status dynamic later if needed
-                # Pass the new optional fields
-                processing_time_ms=processing_duration_ms,
-                task_complete=task_complete_status, # Pass current value
-                hand_off_to_human=needs_handoff, # Pass current value
-                hand_off_to_human_reason=handoff_reason # Pass current value
-            )
+            with metrics.timer('finalize'):
+                update_status, update_error_msg = dynamodb_service.update_conversation_after_reply(
+                    primary_channel_pk=primary_channel,
+                    conversation_id_sk=conversation_id,
+                    user_message_map=user_message_map,
+                    assistant_message_map=assistant_message_map,
+                    new_status="reply_sent", # TODO: Make status dynamic later if needed
+                    # Pass the new optional fields
+                    processing_time_ms=processing_duration_ms,
+                    task_complete=task_complete_status, # Pass current value
+                    hand_off_to_human=needs_handoff, # Pass current value
+                    hand_off_to_human_reason=handoff_reason, # Pass current value
+                    **update_kwargs
+                )
 
             if update_status == dynamodb_service.DB_SUCCESS:
                 logger.info(f"Final DB update successful for {conversation_id}.")
@@ -448,6 +915,11 @@ def handler(event, context):
             elif update_status == dynamodb_service.DB_LOCK_LOST:
                 logger.critical(f"CRITICAL: Final update failed for {conversation_id} because lock was lost after message was sent! Manual investigation needed. Error: {update_error_msg}")
                 continue 
+            elif outbox_sent:
+                # DB_ERROR - the outbox holds the sent reply, so the retry only repeats this update
+                logger.error(f"Final DB update failed for {conversation_id} after the reply was sent: {update_error_msg}. Failing message {message_id} to store it on retry.")
+                batch_item_failures.append({"itemIdentifier": message_id})
+                continue
             else: # DB_ERROR
                 logger.critical(f"CRITICAL: Final DB update failed for {conversation_id} after message was sent! Error: {update_error_msg}. Manual investigation needed.")
                 continue
@@ -464,13 +936,29 @@ def handler(event, context):
                      if item.get('conversation_id') and item.get('message_sid') # Ensure keys are present
                  ]
 
+            # The reply's outbox goes with its fragments, as do outboxes of replies it superseded
+            finished_outboxes = [outbox] if outbox is not None else outboxes
+            outbox_keys = [{'conversation_id': conversation_id, 'message_sid': item.get('message_sid')} for item in finished_outboxes]
+            if outbox_record is not None:
+                outbox_keys.append(dynamodb_service.outbox_key(conversation_id, first_message_sid))
+            for key in outbox_keys:
+                if key not in keys_to_delete_staging:
+                    keys_to_delete_staging.append(key)
+
             if not keys_to_delete_staging:
                  logger.warning(f"No valid keys extracted from staged_items for cleanup of conversation {conversation_id}")
                  # Decide if this is an error or just informational
 
             # Call cleanup functions
-            cleanup_staging_success = dynamodb_service.cleanup_staging_table(keys_to_delete_staging)
-            cleanup_lock_success = dynamodb_service.cleanup_trigger_lock(conversation_id)
+            with metrics.timer('cleanup'):
+                cleanup_staging_success = dynamodb_service.cleanup_staging_table(keys_to_delete_staging)
+                if fifo_queue:
+                    # FIFO triggers are deduplicated by SQS - there is no trigger lock
+                    cleanup_lock_success = True
+                else:
+                    cleanup_lock_success = dynamodb_service.cleanup_trigger_lock(
+                        conversation_id, batch_stats=_summarize_batch_timing(staged_items)
+                    )
 
             # Log warnings on failure, but don't fail the overall process
             if not cleanup_staging_success:
@@ -481,6 +969,22 @@ def handler(event, context):
             if cleanup_staging_success and cleanup_lock_success:
                  logger.info(f"Cleanup successful for {conversation_id}.")
 
+            # Fragments that arrived after a resumed reply need a trigger of their own
+            # (on FIFO queues the staging Lambda already sent one)
+            if leftover_items and not fifo_queue:
+                logger.info(f"Queueing a trigger for {len(leftover_items)} newer fragment(s) of {conversation_id}.")
+                if sqs_service.send_message(whatsapp_queue_url, {'conversation_id': conversation_id, 'primary_channel': primary_channel}) != sqs_service.SQS_SENT:
+                    logger.error(f"Could not queue a trigger for the newer fragments of {conversation_id}. They are answered with the next message.")
+
+            # --- Step 13b: Context Compaction (summarize strategy only) --- #
+            if window['active'] and window['strategy'] == context_window.STRATEGY_SUMMARIZE:
+                known_history = history if history is not None else db_data.get('messages')
+                try:
+                    _compact_context(primary_channel, conversation_id, window, known_history,
+                                     [user_message_map, assistant_message_map], ai_input_api_key)
+                except Exception as compact_ex:
+                    logger.exception(f"Context compaction failed for {conversation_id}, the next reply retries it: {compact_ex}")
+
             # Step 14 (Release Lock) is implicitly handled by Step 12 setting status != processing_reply
             # Step 15 (Lambda Message Success) is handled by reaching end of try block
 
@@ -511,11 +1015,17 @@ def handler(event, context):
             else:
                 logger.debug(f"No active heartbeat to stop in finally block for {message_id}.")
 
+            # --- Release the company concurrency slot if one was taken --- #
+            if concurrency_slot:
+                if not dynamodb_service.release_concurrency_slot(concurrency_slot[0], concurrency_slot[1], conversation_id):
+                    logger.error(f"Failed to release concurrency slot for {conversation_id}. Lease expiry will free it.")
+
             # --- Release processing lock if it was acquired --- #
             if lock_status == dynamodb_service.LOCK_ACQUIRED and primary_channel and conversation_id:
                 # Check if an error occurred that requires releasing the lock
                 # An error occurred if the message_id is in batch_item_failures AND it wasn't just a heartbeat error
-                processing_failed = any(f['itemIdentifier'] == message_id for f in batch_item_failures)
+                # Deferred records give the lock back too, so the retry can take it
+                processing_failed = deferred or any(f['itemIdentifier'] == message_id for f in batch_item_failures)
                 
                 if processing_failed and not heartbeat_exception:
                     logger.warning(f"Attempting to release lock for {primary_channel}/{conversation_id} (setting status to retry) due to processing exception...")
@@ -537,6 +1047,15 @@ def handler(event, context):
                 logger.debug(f"Lock was not acquired for {message_id} (status: {lock_status}), no release needed in finally.")
             # else: lock_status is None if parsing failed very early
 
+            if message_group_id and (deferred or any(f['itemIdentifier'] == message_id for f in batch_item_failures)):
+                failed_message_groups.add(message_group_id)
+
+            metrics.put_metric('record_total', round((time.perf_counter() - record_timer_start) * 1000.0, 3))
+            if deferred:
+                metrics.put_metric('record_deferred', 1, metrics.UNIT_COUNT)
+            elif any(f['itemIdentifier'] == message_id for f in batch_item_failures):
+                metrics.put_metric('record_failed', 1, metrics.UNIT_COUNT)
+
     # Return response indicating which items failed, if any
     response = {"batchItemFailures": batch_item_failures}
     logger.info(f"Lambda execution finished. Returning response: {response}")
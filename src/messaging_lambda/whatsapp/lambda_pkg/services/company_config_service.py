@@ -0,0 +1,167 @@
+# services/company_config_service.py - Messaging Lambda (WhatsApp)
+"""
+Company/project configuration, read from the company-data table and cached per
+warm container.
+
+When COMPANY_DATA_TABLE_NAME is set, hydration reads only the per-conversation
+fields of the conversation item (dynamodb_service.CONVERSATION_FIELDS) and the
+config comes from here. Entries are version-stamped with `config_version` and
+`updated_at`; once COMPANY_CONFIG_CACHE_TTL_SECONDS have passed
+only the version is re-read, and the full record only when it has changed.
+"""
+
+import os
+import time
+import logging
+import threading
+from botocore.exceptions import ClientError
+from typing import Dict, Any, Optional, Tuple
+
+from ..utils import aws_clients, retry_policy
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+
+# --- Status Codes (same contract as the Staging Lambda's copy) --- #
+CONFIG_FOUND = "FOUND"
+CONFIG_NOT_FOUND = "NOT_FOUND"
+CONFIG_DISABLED = "DISABLED"
+CONFIG_DB_ERROR = "DB_ERROR"
+# --- End Status Codes --- #
+
+COMPANY_DATA_TABLE_NAME = os.environ.get('COMPANY_DATA_TABLE_NAME', '')
+COMPANY_CONFIG_CACHE_TTL_SECONDS = int(os.environ.get('COMPANY_CONFIG_CACHE_TTL_SECONDS', '300'))
+
+# Company-level fields that conversation items also carry a copy of
+CONFIG_FIELDS = (
+    'allowed_channels',
+    'ai_config',
+    'channel_config',
+    'auto_queue_initial_message',
+    'auto_queue_initial_message_from_number',
+    'auto_queue_initial_message_from_email',
+    'auto_queue_reply_message',
+    'auto_queue_reply_message_from_number',
+    'auto_queue_reply_message_from_email',
+    'rate_limits',
+    'company_rep',
+    'project_status',
+    'company_name',
+    'project_name',
+)
+
+company_data_table = None
+if COMPANY_DATA_TABLE_NAME:
+    try:
+        company_data_table = aws_clients.resource('dynamodb').Table(COMPANY_DATA_TABLE_NAME)
+        logger.info(f"Company config cache initialized for table: {COMPANY_DATA_TABLE_NAME}")
+    except Exception as e:
+        logger.critical(f"Failed to initialize company data table {COMPANY_DATA_TABLE_NAME}: {e}")
+        company_data_table = None
+
+# (company_id, project_id) -> {'record': dict or None, 'version': ..., 'checked_at': epoch}
+_cache = {}
+_lock = threading.Lock()
+
+
+def is_enabled() -> bool:
+    """True when a company-data table is configured."""
+    return company_data_table is not None
+
+
+def _version(record: Optional[Dict[str, Any]]):
+    if not record:
+        return None
+    # Both stamps: an edit that kept config_version but moved updated_at still counts
+    return (record.get('config_version'), record.get('updated_at'))
+
+
+def _read(company_id: str, project_id: str, version_only: bool = False) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """GetItem on the company-data table."""
+    kwargs = {'Key': {'company_id': company_id, 'project_id': project_id}}
+    if version_only:
+        kwargs['ProjectionExpression'] = 'config_version, updated_at'
+    try:
+        item = retry_policy.call('dynamodb.get_item', company_data_table.get_item, **kwargs).get('Item')
+    except ClientError as e:
+        logger.error(f"DynamoDB ClientError reading company config {company_id}/{project_id}: {e}")
+        return CONFIG_DB_ERROR, None
+    except Exception as e:
+        logger.exception(f"Unexpected error reading company config {company_id}/{project_id}: {e}")
+        return CONFIG_DB_ERROR, None
+    return (CONFIG_FOUND, item) if item else (CONFIG_NOT_FOUND, None)
+
+
+def _result(entry: Dict[str, Any]) -> Tuple[str, Optional[Dict[str, Any]]]:
+    if entry['record'] is None:
+        return CONFIG_NOT_FOUND, None
+    return CONFIG_FOUND, entry['record']
+
+
+def get_company_config(company_id: str, project_id: str) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """
+    Returns the company-data record for a company/project.
+
+    Returns:
+        A tuple containing:
+        - status_code (str): CONFIG_FOUND, CONFIG_NOT_FOUND (cached too), CONFIG_DISABLED or CONFIG_DB_ERROR.
+        - record (Optional[Dict[str, Any]]): The company-data record when found, else None.
+    """
+    if not company_data_table:
+        return CONFIG_DISABLED, None
+    if not company_id or not project_id:
+        return CONFIG_NOT_FOUND, None
+
+    key = (company_id, project_id)
+    now = time.time()
+    with _lock:
+        entry = _cache.get(key)
+    if entry and now - entry['checked_at'] < COMPANY_CONFIG_CACHE_TTL_SECONDS:
+        return _result(entry)
+
+    if entry:
+        # Expired - only re-read the full record if its version has moved on
+        status, stamp = _read(company_id, project_id, version_only=True)
+        if status == CONFIG_DB_ERROR:
+            logger.warning(f"Could not revalidate company config {company_id}/{project_id}; serving cached copy")
+            unchanged = True
+        else:
+            unchanged = (stamp is None) == (entry['record'] is None) and _version(stamp) == entry['version']
+        if unchanged:
+            with _lock:
+                entry['checked_at'] = now
+            return _result(entry)
+        logger.info(f"Company config {company_id}/{project_id} changed (version {entry['version']} -> {_version(stamp)}); reloading")
+
+    status, record = _read(company_id, project_id)
+    if status == CONFIG_DB_ERROR:
+        return CONFIG_DB_ERROR, None
+    entry = {'record': record, 'version': _version(record), 'checked_at': now}
+    with _lock:
+        _cache[key] = entry
+    return _result(entry)
+
+
+def channel_view(record: Dict[str, Any], channel: str) -> Dict[str, Any]:
+    """
+    Flattens a company-data record into the shape conversation items use: `ai_config`
+    and `channel_config` hold only the given channel's settings.
+    """
+    view = {field: record[field] for field in CONFIG_FIELDS
+            if field in record and field not in ('ai_config', 'channel_config')}
+    ai_config = ((record.get('ai_config') or {}).get('openai_config') or {}).get(channel)
+    if ai_config:
+        view['ai_config'] = ai_config
+    channel_config = (record.get('channel_config') or {}).get(channel)
+    if channel_config:
+        view['channel_config'] = channel_config
+    return view
+
+
+def invalidate(company_id: Optional[str] = None, project_id: Optional[str] = None) -> None:
+    """Drops cached config for one company/project, or everything if called without arguments."""
+    with _lock:
+        if company_id is None:
+            _cache.clear()
+        else:
+            _cache.pop((company_id, project_id), None)
@@ -2,11 +2,14 @@
 
 import os
 import logging
-import boto3
+import functools
 from botocore.exceptions import ClientError
 from typing import Dict, Any, Tuple, Optional
 from datetime import datetime, timezone
-import json
+import time
+
+from . import dynamodb_lowlevel
+from ..utils import aws_clients, retry_policy
 
 logger = logging.getLogger(__name__)
 logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
@@ -21,13 +24,82 @@ DB_LOCK_LOST = "LOCK_LOST"
 
 # Define the status value used for locking
 PROCESSING_STATUS = "processing_reply"
+# A reply waiting on an OpenAI batch (core/batch_service.py); the conversation is not locked
+BATCH_PENDING_STATUS = "batch_pending"
+# claim_batch_reply: the conversation moved on (newer request, or already answered)
+BATCH_SUPERSEDED = "SUPERSEDED"
+# Batch tracking items in the trigger-lock table outlive the 24h completion window
+BATCH_RECORD_TTL_SECONDS = int(os.environ.get('BATCH_RECORD_TTL_SECONDS', str(3 * 24 * 3600)))
+OPEN_BATCHES_KEY = "batches#open"
+
+# Trigger-lock items also hold batch timing stats for the adaptive batch window (StagingLambda)
+BATCH_STATS_TTL_SECONDS = int(os.environ.get('BATCH_STATS_TTL_SECONDS', str(7 * 24 * 3600)))
+
+# Reply outbox records sit in the stage table next to the fragments they answer,
+# under message_sid 'outbox#<first_message_sid>' (see save_reply_outbox)
+OUTBOX_SID_PREFIX = "outbox#"
+OUTBOX_AI_COMPLETE = "ai_complete"
+OUTBOX_SENT = "sent"
+# Outlives every SQS redelivery of the trigger (maxReceiveCount x visibility timeout)
+REPLY_OUTBOX_TTL_SECONDS = int(os.environ.get('REPLY_OUTBOX_TTL_SECONDS', str(24 * 3600)))
+
+# Per-conversation attributes read during hydration when company config comes from
+# company_config_service (the item's copy of the config and its message history are skipped)
+CONVERSATION_FIELDS = (
+    'primary_channel', 'conversation_id', 'company_id', 'project_id', 'request_id',
+    'channel_method', 'conversation_status', 'hand_off_to_human', 'hand_off_to_human_reason',
+    'task_complete', 'thread_id', 'recipient_tel', 'recipient_email', 'recipient_first_name',
+    'recipient_last_name', 'comms_consent', 'created_at', 'updated_at',
+    'context_tokens', 'total_tokens_used', 'context_window', 'batch_request'
+)
+
+# Per-company concurrency semaphore (items in the trigger-lock table)
+SEMAPHORE_ACQUIRED = "SEMAPHORE_ACQUIRED"
+SEMAPHORE_FULL = "SEMAPHORE_FULL"
+# A slot held by a crashed invocation frees itself after this long (Lambda timeout + margin)
+CONCURRENCY_LEASE_SECONDS = int(os.environ.get('CONCURRENCY_LEASE_SECONDS', '960'))
+# Optimistic-concurrency retries when several invocations update the same semaphore
+SEMAPHORE_MAX_ATTEMPTS = 3
+
+# Precompiled expressions for the per-record calls (see dynamodb_lowlevel)
+PROCESSING_LOCK_UPDATE = "SET conversation_status = :proc_status"
+PROCESSING_LOCK_CONDITION = "attribute_not_exists(conversation_status) OR conversation_status <> :proc_status"
+STAGING_KEY_CONDITION = "conversation_id = :cid"
+FINAL_UPDATE_CONDITION = "#status = :lock_status"
+# A reply resumed from its outbox is not appended again once its user message is stored
+FINAL_UPDATE_REPLY_CONDITION = "#status = :lock_status AND (attribute_not_exists(#reply_to) OR #reply_to <> :reply_to)"
+FINAL_UPDATE_STORED_RELEASE = "SET #status = :new_status, #updated = :ts"
+FINAL_UPDATE_STORED_CONDITION = "#status = :lock_status AND #reply_to = :reply_to"
+# Optional SET clauses of the final update: attribute -> (name placeholder, value placeholder)
+FINAL_UPDATE_OPTIONAL_FIELDS = {
+    'openai_thread_id': ('#tid', ':tid'),
+    'initial_processing_time_ms': ('#proc_time', ':proc_time'),
+    'task_complete': ('#task_comp', ':task_comp'),
+    'hand_off_to_human': ('#handoff', ':handoff'),
+    'hand_off_to_human_reason': ('#handoff_reason', ':handoff_reason'),
+    'context_tokens': ('#ctx_tokens', ':ctx_tokens'),
+    'context_window': ('#ctx_window', ':ctx_window'),
+    'last_reply_to': ('#reply_to', ':reply_to'),
+}
+# Optional counters of the final update (added to the stored value)
+FINAL_UPDATE_COUNTERS = {
+    'total_tokens_used': ('#tokens_used', ':tokens_used'),
+}
+CONTEXT_WINDOW_CONDITION = "#ctx_window.#covers = :expected_covers"
+BATCH_PARK_UPDATE = "SET #status = :batch_status, #updated = :ts, #batch_req = :batch_req"
+BATCH_CLAIM_UPDATE = "SET #status = :proc_status, #updated = :ts REMOVE #batch_req"
+BATCH_RELEASE_UPDATE = "SET #status = :retry_status, #updated = :ts"
+BATCH_REQUEST_CONDITION = "#status = :batch_status AND #batch_req.#custom_id = :custom_id"
 
 # Initialize DynamoDB client/resource and table objects
+dynamodb_client = None
 conversations_table = None
 conversations_stage_table = None
 conversations_trigger_lock_table = None
 try:
-    dynamodb_resource = boto3.resource('dynamodb')
+    dynamodb_resource = aws_clients.resource('dynamodb')
+    # Per-record calls go through dynamodb_lowlevel on the plain (wire-format) client
+    dynamodb_client = aws_clients.client('dynamodb')
 
     # Initialize main conversations table
     conversations_table_name = os.environ.get('CONVERSATIONS_TABLE')
@@ -58,6 +130,7 @@ except EnvironmentError as env_err:
     raise
 except Exception as e:
     logger.critical(f"Failed to initialize DynamoDB resource/tables: {e}")
+    dynamodb_client = None
     conversations_table = None
     conversations_stage_table = None
     conversations_trigger_lock_table = None
@@ -80,14 +153,14 @@ def acquire_processing_lock(primary_channel: str, conversation_id: str) -> str:
 
     logger.info(f"Attempting to acquire lock for {primary_channel}/{conversation_id}")
     try:
-        conversations_table.update_item(
-            Key={
-                'primary_channel': primary_channel,
-                'conversation_id': conversation_id
-            },
-            UpdateExpression="SET conversation_status = :proc_status",
-            ConditionExpression="attribute_not_exists(conversation_status) OR conversation_status <> :proc_status",
-            ExpressionAttributeValues={':proc_status': PROCESSING_STATUS}
+        # Conditional write - only throttling errors are retried
+        retry_policy.call(
+            'dynamodb.update_item', dynamodb_lowlevel.update_item, dynamodb_client, conversations_table.name,
+            {'primary_channel': primary_channel, 'conversation_id': conversation_id},
+            PROCESSING_LOCK_UPDATE,
+            condition=PROCESSING_LOCK_CONDITION,
+            values={':proc_status': PROCESSING_STATUS},
+            idempotent=False
         )
         logger.info(f"Successfully acquired lock for {primary_channel}/{conversation_id}")
         return LOCK_ACQUIRED
@@ -121,11 +194,11 @@ def query_staging_table(conversation_id: str) -> list | None:
 
     logger.info(f"Querying staging table for conversation_id: {conversation_id}")
     try:
-        response = conversations_stage_table.query(
-            KeyConditionExpression=boto3.dynamodb.conditions.Key('conversation_id').eq(conversation_id),
-            ConsistentRead=True # Ensure we read the latest writes from StagingLambda
+        items = retry_policy.call(
+            'dynamodb.query', dynamodb_lowlevel.query, dynamodb_client, conversations_stage_table.name,
+            STAGING_KEY_CONDITION, {':cid': conversation_id},
+            consistent_read=True # Ensure we read the latest writes from StagingLambda
         )
-        items = response.get('Items', [])
         logger.info(f"Found {len(items)} items in staging table for conversation_id: {conversation_id}")
         return items
 
@@ -136,7 +209,7 @@ def query_staging_table(conversation_id: str) -> list | None:
         logger.exception(f"Unexpected error querying staging table for {conversation_id}: {e}")
         return None # Indicate error
 
-def get_conversation_item(primary_channel: str, conversation_id: str) -> dict | None:
+def get_conversation_item(primary_channel: str, conversation_id: str, attributes: Optional[Tuple[str, ...]] = None) -> dict | None:
     """
     Fetches the full conversation item from the main ConversationsTable.
     Uses a strongly consistent read.
@@ -144,6 +217,7 @@ def get_conversation_item(primary_channel: str, conversation_id: str) -> dict |
     Args:
         primary_channel: The Partition Key.
         conversation_id: The Sort Key.
+        attributes: Optional attribute names to read instead of the whole item (e.g. CONVERSATION_FIELDS).
 
     Returns:
         The conversation item dictionary if found, None if not found or an error occurs.
@@ -154,14 +228,12 @@ def get_conversation_item(primary_channel: str, conversation_id: str) -> dict |
 
     logger.info(f"Fetching conversation item for PK={primary_channel}, SK={conversation_id}")
     try:
-        response = conversations_table.get_item(
-            Key={
-                'primary_channel': primary_channel,
-                'conversation_id': conversation_id
-            },
-            ConsistentRead=True
+        item = retry_policy.call(
+            'dynamodb.get_item', dynamodb_lowlevel.get_item, dynamodb_client, conversations_table.name,
+            {'primary_channel': primary_channel, 'conversation_id': conversation_id},
+            consistent_read=True,
+            attributes=attributes
         )
-        item = response.get('Item')
         if not item:
             logger.error(f"Conversation item not found for PK={primary_channel}, SK={conversation_id}")
             return None # Explicitly return None for not found
@@ -176,6 +248,28 @@ def get_conversation_item(primary_channel: str, conversation_id: str) -> dict |
         logger.exception(f"Unexpected error getting item for {primary_channel}/{conversation_id}: {e}")
         return None # Indicate error
 
+@functools.lru_cache(maxsize=64)
+def _final_update_template(optional_fields: Tuple[str, ...], clear_batch_request: bool = False) -> Tuple[str, Dict[str, str]]:
+    """UpdateExpression and ExpressionAttributeNames of the final update for a set of optional fields."""
+    parts = [
+        "#status = :new_status",
+        "#updated = :ts",
+        "#msgs = list_append(if_not_exists(#msgs, :empty_list), :new_msgs)",
+    ]
+    names = {"#status": "conversation_status", "#updated": "updated_at", "#msgs": "messages"}
+    for attribute in optional_fields:
+        if attribute in FINAL_UPDATE_COUNTERS:
+            name_placeholder, value_placeholder = FINAL_UPDATE_COUNTERS[attribute]
+            parts.append(f"{name_placeholder} = if_not_exists({name_placeholder}, :zero) + {value_placeholder}")
+        else:
+            name_placeholder, value_placeholder = FINAL_UPDATE_OPTIONAL_FIELDS[attribute]
+            parts.append(f"{name_placeholder} = {value_placeholder}")
+        names[name_placeholder] = attribute
+    if clear_batch_request:
+        names["#batch_req"] = "batch_request"
+        return "SET " + ", ".join(parts) + " REMOVE #batch_req", names
+    return "SET " + ", ".join(parts), names
+
 def update_conversation_after_reply(
     primary_channel_pk: str,
     conversation_id_sk: str,
@@ -186,13 +280,20 @@ def update_conversation_after_reply(
     task_complete: Optional[int] = None,
     hand_off_to_human: Optional[bool] = None,
     hand_off_to_human_reason: Optional[str] = None,
-    updated_openai_thread_id: Optional[str] = None
+    updated_openai_thread_id: Optional[str] = None,
+    context_window: Optional[Dict[str, Any]] = None,
+    clear_batch_request: bool = False
 ) -> Tuple[str, Optional[str]]: # Return status code and error message
     """
     Performs the final update after AI processing and Twilio send.
     Atomically appends BOTH the user message and the assistant message to the history.
     Updates status, timestamps, and potentially other fields.
     Crucially uses a ConditionExpression to ensure the lock is still held.
+    The user message id is stored as last_reply_to: an update for a reply that
+    is already stored (e.g. resumed from its outbox after the cleanup failed)
+    only releases the lock instead of appending the history again.
+    Token usage on the assistant message is recorded as the conversation's
+    current context size (context_tokens) and added to total_tokens_used.
 
     Args:
         primary_channel_pk: The Partition Key.
@@ -205,6 +306,8 @@ def update_conversation_after_reply(
         hand_off_to_human: Optional handoff flag.
         hand_off_to_human_reason: Optional reason for handoff.
         updated_openai_thread_id: Optional updated thread ID (if applicable).
+        context_window: Optional context window state to store (see core/context_window.py).
+        clear_batch_request: Removes a pending batch request this reply answered.
 
     Returns:
         A tuple: (status_code, error_message)
@@ -221,85 +324,66 @@ def update_conversation_after_reply(
 
     logger.info(f"Attempting final update for conversation {conversation_id_sk}")
 
-    # Prepare the update expression
-    update_expression_parts = []
-    expression_attribute_values = {}
-    expression_attribute_names = {}
-
-    # Always update status and timestamp
-    update_expression_parts.append("#status = :new_status")
-    update_expression_parts.append("#updated = :ts")
-    expression_attribute_names["#status"] = "conversation_status"
-    expression_attribute_names["#updated"] = "updated_at"
-    expression_attribute_values[":new_status"] = new_status
-    expression_attribute_values[":ts"] = datetime.now(timezone.utc).isoformat()
-
-    # Append both messages
-    update_expression_parts.append("#msgs = list_append(if_not_exists(#msgs, :empty_list), :new_msgs)")
-    expression_attribute_names["#msgs"] = "messages"
-    expression_attribute_values[":new_msgs"] = [user_message_map, assistant_message_map]
-    expression_attribute_values[":empty_list"] = []
-
-    # --- Conditionally add other updates --- #
+    # Optional fields being set -> precompiled template for that combination
+    optional_values = {}
     if updated_openai_thread_id:
-        update_expression_parts.append("#tid = :tid")
-        expression_attribute_names["#tid"] = "openai_thread_id"
-        expression_attribute_values[":tid"] = updated_openai_thread_id
-
+        optional_values['openai_thread_id'] = updated_openai_thread_id
     if processing_time_ms is not None:
-        update_expression_parts.append("#proc_time = :proc_time")
-        expression_attribute_names["#proc_time"] = "initial_processing_time_ms" # Corrected attribute name
-        expression_attribute_values[":proc_time"] = processing_time_ms
-
+        optional_values['initial_processing_time_ms'] = processing_time_ms
     if task_complete is not None: # Allows setting 0 or 1
-        update_expression_parts.append("#task_comp = :task_comp")
-        expression_attribute_names["#task_comp"] = "task_complete"
-        expression_attribute_values[":task_comp"] = task_complete
-
+        optional_values['task_complete'] = task_complete
     if hand_off_to_human is not None:
-        update_expression_parts.append("#handoff = :handoff")
-        expression_attribute_names["#handoff"] = "hand_off_to_human"
-        expression_attribute_values[":handoff"] = hand_off_to_human
-
-    # Only set reason if handoff is True or reason is explicitly provided
-    if hand_off_to_human_reason is not None:
-        update_expression_parts.append("#handoff_reason = :handoff_reason")
-        expression_attribute_names["#handoff_reason"] = "hand_off_to_human_reason"
-        expression_attribute_values[":handoff_reason"] = hand_off_to_human_reason
-    elif hand_off_to_human: # If handoff is True but no reason given, explicitly set reason to None/Null
-        update_expression_parts.append("#handoff_reason = :null_reason")
-        expression_attribute_names["#handoff_reason"] = "hand_off_to_human_reason"
-        expression_attribute_values[":null_reason"] = None # Let Boto3 handle None
-
-    # --- Construct final expression --- #
-    final_update_expression = "SET " + ", ".join(update_expression_parts)
-
-    # --- Define Condition Expression (Check lock) --- #
-    condition_expression = "#status = :lock_status" # Check that status IS processing_reply
-    expression_attribute_values[":lock_status"] = PROCESSING_STATUS # Use the constant defined above
-
-    logger.debug(f"Final Update Expression: {final_update_expression}")
-    logger.debug(f"Condition Expression: {condition_expression}")
-    logger.debug(f"Expression Attribute Values: {json.dumps(expression_attribute_values, default=str)}") # Use json.dumps for logging potentially complex values
-    logger.debug(f"Expression Attribute Names: {expression_attribute_names}")
+        optional_values['hand_off_to_human'] = hand_off_to_human
+    # Only set reason if handoff is True or reason is explicitly provided (None is written as NULL)
+    if hand_off_to_human_reason is not None or hand_off_to_human:
+        optional_values['hand_off_to_human_reason'] = hand_off_to_human_reason
+    if assistant_message_map.get('prompt_tokens') is not None:
+        optional_values['context_tokens'] = int(assistant_message_map['prompt_tokens'])
+    if assistant_message_map.get('total_tokens') is not None:
+        optional_values['total_tokens_used'] = int(assistant_message_map['total_tokens'])
+    if context_window is not None:
+        optional_values['context_window'] = context_window
+    if user_message_map.get('message_id'):
+        optional_values['last_reply_to'] = user_message_map['message_id']
+
+    update_expression, expression_attribute_names = _final_update_template(tuple(optional_values), clear_batch_request)
+    expression_attribute_values = {
+        ':new_status': new_status,
+        ':ts': datetime.now(timezone.utc).isoformat(),
+        ':new_msgs': [user_message_map, assistant_message_map],
+        ':empty_list': [],
+        ':lock_status': PROCESSING_STATUS, # Check that status IS still processing_reply
+    }
+    for attribute, value in optional_values.items():
+        if attribute in FINAL_UPDATE_COUNTERS:
+            expression_attribute_values[FINAL_UPDATE_COUNTERS[attribute][1]] = value
+            expression_attribute_values[':zero'] = 0
+        else:
+            expression_attribute_values[FINAL_UPDATE_OPTIONAL_FIELDS[attribute][1]] = value
+
+    logger.debug(f"Final Update Expression: {update_expression}")
 
     try:
-        conversations_table.update_item(
-            Key={
-                'primary_channel': primary_channel_pk,
-                'conversation_id': conversation_id_sk
-            },
-            UpdateExpression=final_update_expression,
-            ConditionExpression=condition_expression,
-            ExpressionAttributeNames=expression_attribute_names,
-            ExpressionAttributeValues=expression_attribute_values,
-            ReturnValues="NONE"
+        # Appends to the message history under the lock condition - only throttling errors are retried
+        retry_policy.call(
+            'dynamodb.update_item', dynamodb_lowlevel.update_item, dynamodb_client, conversations_table.name,
+            {'primary_channel': primary_channel_pk, 'conversation_id': conversation_id_sk},
+            update_expression,
+            condition=FINAL_UPDATE_REPLY_CONDITION if 'last_reply_to' in optional_values else FINAL_UPDATE_CONDITION,
+            names=expression_attribute_names,
+            values=expression_attribute_values,
+            idempotent=False
         )
         logger.info(f"Successfully performed final update for conversation {conversation_id_sk}.")
         return DB_SUCCESS, None
 
     except ClientError as e:
         error_code = e.response['Error']['Code']
+        if error_code == 'ConditionalCheckFailedException' and 'last_reply_to' in optional_values \
+                and _release_stored_reply(primary_channel_pk, conversation_id_sk, optional_values['last_reply_to'],
+                                          new_status, expression_attribute_values[':ts']):
+            logger.info(f"Reply to {optional_values['last_reply_to']} was already stored for {conversation_id_sk}. Released the lock only.")
+            return DB_SUCCESS, None
         if error_code == 'ConditionalCheckFailedException':
             logger.warning(f"Final update failed for {conversation_id_sk} because lock was lost (ConditionalCheckFailedException). Status likely changed.")
             return DB_LOCK_LOST, "ConditionalCheckFailedException - Lock lost or status changed before final update."
@@ -312,6 +396,293 @@ def update_conversation_after_reply(
         logger.exception(error_msg)
         return DB_ERROR, error_msg
 
+def _release_stored_reply(primary_channel: str, conversation_id: str, reply_to: str, new_status: str, timestamp: str) -> bool:
+    """Sets the final status without touching the history if the reply to reply_to is already stored under our lock."""
+    try:
+        retry_policy.call(
+            'dynamodb.update_item', dynamodb_lowlevel.update_item, dynamodb_client, conversations_table.name,
+            {'primary_channel': primary_channel, 'conversation_id': conversation_id},
+            FINAL_UPDATE_STORED_RELEASE,
+            condition=FINAL_UPDATE_STORED_CONDITION,
+            names={'#status': 'conversation_status', '#updated': 'updated_at', '#reply_to': 'last_reply_to'},
+            values={':new_status': new_status, ':ts': timestamp, ':lock_status': PROCESSING_STATUS, ':reply_to': reply_to}
+        )
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            logger.error(f"DynamoDB ClientError releasing the lock of stored reply for {conversation_id}: {e}")
+        return False
+
+def update_context_window(primary_channel: str, conversation_id: str, context_window: Dict[str, Any],
+                          expected_covers: int) -> bool:
+    """
+    Replaces the conversation's context window state (e.g. a new rolling summary),
+    unless another invocation has already moved it past expected_covers.
+
+    Returns:
+        True if the state was written, False otherwise.
+    """
+    if not conversations_table:
+        logger.error("DynamoDB conversations table not initialized. Cannot update context window.")
+        return False
+
+    try:
+        retry_policy.call(
+            'dynamodb.update_item', dynamodb_lowlevel.update_item, dynamodb_client, conversations_table.name,
+            {'primary_channel': primary_channel, 'conversation_id': conversation_id},
+            "SET #ctx_window = :ctx_window",
+            condition=CONTEXT_WINDOW_CONDITION,
+            names={'#ctx_window': 'context_window', '#covers': 'covers'},
+            values={':ctx_window': context_window, ':expected_covers': expected_covers},
+        )
+        logger.info(f"Stored context window for {conversation_id} (covers {context_window.get('covers')} messages).")
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            logger.warning(f"Context window of {conversation_id} changed since it was read; not overwriting it.")
+        else:
+            logger.error(f"DynamoDB ClientError updating context window for {conversation_id}: {e}")
+        return False
+    except Exception as e:
+        logger.exception(f"Unexpected error updating context window for {conversation_id}: {e}")
+        return False
+
+# --- Batch Replies (core/batch_service.py, batch_runner.py) --- #
+
+def _batch_request_call(primary_channel: str, conversation_id: str, update_expression: str,
+                        values: Dict[str, Any], condition: Optional[str] = None, return_values: Optional[str] = None):
+    """Conditional update of a conversation's batch request state - only throttling errors are retried."""
+    names = {'#status': 'conversation_status', '#updated': 'updated_at', '#batch_req': 'batch_request', '#custom_id': 'custom_id'}
+    return retry_policy.call(
+        'dynamodb.update_item', dynamodb_lowlevel.update_item, dynamodb_client, conversations_table.name,
+        {'primary_channel': primary_channel, 'conversation_id': conversation_id},
+        update_expression,
+        condition=condition,
+        names={k: v for k, v in names.items() if k in update_expression or k in (condition or '')},
+        values=dict(values, **{':ts': datetime.now(timezone.utc).isoformat()}),
+        return_values=return_values,
+        idempotent=False
+    )
+
+def park_for_batch(primary_channel: str, conversation_id: str, batch_request: Dict[str, Any]) -> Tuple[str, Optional[str]]:
+    """
+    Hands a locked conversation's reply over to a batch: stores the pending
+    request (custom_id, combined_body, first_message_sid, message_sids) and sets
+    the status to BATCH_PENDING_STATUS, which releases the processing lock.
+
+    Returns:
+        (DB_SUCCESS | DB_LOCK_LOST | DB_ERROR, error_message)
+    """
+    if not conversations_table:
+        logger.error("DynamoDB conversations table not initialized. Cannot park conversation for batch.")
+        return DB_ERROR, "DynamoDB table not initialized"
+
+    try:
+        _batch_request_call(
+            primary_channel, conversation_id, BATCH_PARK_UPDATE,
+            {':batch_status': BATCH_PENDING_STATUS, ':batch_req': batch_request, ':lock_status': PROCESSING_STATUS},
+            condition="#status = :lock_status"
+        )
+        logger.info(f"Conversation {conversation_id} is waiting on batch request {batch_request.get('custom_id')}.")
+        return DB_SUCCESS, None
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            logger.warning(f"Could not park {conversation_id} for a batch: lock lost.")
+            return DB_LOCK_LOST, "ConditionalCheckFailedException - Lock lost before parking for batch."
+        error_msg = f"DynamoDB ClientError parking {conversation_id} for batch: {e}"
+        logger.error(error_msg)
+        return DB_ERROR, error_msg
+    except Exception as e:
+        error_msg = f"Unexpected error parking {conversation_id} for batch: {e}"
+        logger.exception(error_msg)
+        return DB_ERROR, error_msg
+
+def claim_batch_reply(primary_channel: str, conversation_id: str, custom_id: str) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """
+    Takes the processing lock to deliver a batch result, if the conversation is
+    still waiting on exactly that request. The pending request is removed from
+    the item and returned.
+
+    Returns:
+        (LOCK_ACQUIRED, batch_request), (BATCH_SUPERSEDED, None) or (DB_ERROR, None)
+    """
+    if not conversations_table:
+        logger.error("DynamoDB conversations table not initialized. Cannot claim batch reply.")
+        return DB_ERROR, None
+
+    try:
+        old = _batch_request_call(
+            primary_channel, conversation_id, BATCH_CLAIM_UPDATE,
+            {':proc_status': PROCESSING_STATUS, ':batch_status': BATCH_PENDING_STATUS, ':custom_id': custom_id},
+            condition=BATCH_REQUEST_CONDITION,
+            return_values='UPDATED_OLD'
+        )
+        logger.info(f"Claimed {conversation_id} to deliver batch request {custom_id}.")
+        return LOCK_ACQUIRED, old.get('batch_request')
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            logger.info(f"Batch request {custom_id} of {conversation_id} was superseded.")
+            return BATCH_SUPERSEDED, None
+        logger.error(f"DynamoDB ClientError claiming batch reply for {conversation_id}: {e}")
+        return DB_ERROR, None
+    except Exception as e:
+        logger.exception(f"Unexpected error claiming batch reply for {conversation_id}: {e}")
+        return DB_ERROR, None
+
+def release_batch_request(primary_channel: str, conversation_id: str, custom_id: str) -> str:
+    """
+    Sets a conversation whose batch request failed to 'retry', keeping the
+    pending request on the item so a reprocess trigger can answer it.
+
+    Returns:
+        DB_SUCCESS, BATCH_SUPERSEDED or DB_ERROR
+    """
+    if not conversations_table:
+        logger.error("DynamoDB conversations table not initialized. Cannot release batch request.")
+        return DB_ERROR
+
+    try:
+        _batch_request_call(
+            primary_channel, conversation_id, BATCH_RELEASE_UPDATE,
+            {':retry_status': "retry", ':batch_status': BATCH_PENDING_STATUS, ':custom_id': custom_id},
+            condition=BATCH_REQUEST_CONDITION
+        )
+        logger.info(f"Released failed batch request {custom_id}; {conversation_id} set to 'retry'.")
+        return DB_SUCCESS
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return BATCH_SUPERSEDED
+        logger.error(f"DynamoDB ClientError releasing batch request for {conversation_id}: {e}")
+        return DB_ERROR
+    except Exception as e:
+        logger.exception(f"Unexpected error releasing batch request for {conversation_id}: {e}")
+        return DB_ERROR
+
+def _batch_key(batch_id: str) -> Dict[str, str]:
+    return {'conversation_id': f"batch#{batch_id}"}
+
+def record_batch(batch_id: str, api_key_reference: str, requests: Dict[str, Dict[str, str]]) -> bool:
+    """
+    Stores a submitted batch in the trigger-lock table (api_key_reference and
+    custom_id -> {'primary_channel', 'conversation_id'}) and adds it to the set
+    of open batches.
+
+    Returns:
+        True if both writes succeeded, False otherwise.
+    """
+    if not conversations_trigger_lock_table:
+        logger.error("DynamoDB trigger lock table object not initialized. Cannot record batch.")
+        return False
+
+    now = int(time.time())
+    try:
+        retry_policy.call(
+            'dynamodb.put_item', conversations_trigger_lock_table.put_item,
+            Item=dict(_batch_key(batch_id), batch_id=batch_id, api_key_reference=api_key_reference,
+                      requests=requests, submitted_at=now, expires_at=now + BATCH_RECORD_TTL_SECONDS)
+        )
+        retry_policy.call(
+            'dynamodb.update_item', conversations_trigger_lock_table.update_item,
+            Key={'conversation_id': OPEN_BATCHES_KEY},
+            UpdateExpression="ADD batch_ids :batch_id",
+            ExpressionAttributeValues={':batch_id': {batch_id}}
+        )
+        logger.info(f"Recorded batch {batch_id} ({len(requests)} requests).")
+        return True
+    except ClientError as e:
+        logger.error(f"DynamoDB ClientError recording batch {batch_id}: {e}")
+        return False
+    except Exception as e:
+        logger.exception(f"Unexpected error recording batch {batch_id}: {e}")
+        return False
+
+def list_open_batches() -> list | None:
+    """IDs of the batches whose results have not been delivered yet (None on error)."""
+    if not conversations_trigger_lock_table:
+        logger.error("DynamoDB trigger lock table object not initialized. Cannot list batches.")
+        return None
+    try:
+        item = retry_policy.call(
+            'dynamodb.get_item', conversations_trigger_lock_table.get_item,
+            Key={'conversation_id': OPEN_BATCHES_KEY}, ConsistentRead=True
+        ).get('Item') or {}
+        return sorted(item.get('batch_ids') or [])
+    except Exception as e:
+        logger.exception(f"Error listing open batches: {e}")
+        return None
+
+def get_batch_record(batch_id: str) -> dict | None:
+    """The record stored by record_batch (None if missing or on error)."""
+    if not conversations_trigger_lock_table:
+        logger.error("DynamoDB trigger lock table object not initialized. Cannot read batch.")
+        return None
+    try:
+        return retry_policy.call(
+            'dynamodb.get_item', conversations_trigger_lock_table.get_item,
+            Key=_batch_key(batch_id), ConsistentRead=True
+        ).get('Item')
+    except Exception as e:
+        logger.exception(f"Error reading batch {batch_id}: {e}")
+        return None
+
+def close_batch(batch_id: str) -> bool:
+    """Removes a batch from the open set and deletes its record."""
+    if not conversations_trigger_lock_table:
+        logger.error("DynamoDB trigger lock table object not initialized. Cannot close batch.")
+        return False
+    try:
+        retry_policy.call(
+            'dynamodb.update_item', conversations_trigger_lock_table.update_item,
+            Key={'conversation_id': OPEN_BATCHES_KEY},
+            UpdateExpression="DELETE batch_ids :batch_id",
+            ExpressionAttributeValues={':batch_id': {batch_id}}
+        )
+        retry_policy.call('dynamodb.delete_item', conversations_trigger_lock_table.delete_item, Key=_batch_key(batch_id))
+        logger.info(f"Closed batch {batch_id}.")
+        return True
+    except Exception as e:
+        logger.exception(f"Error closing batch {batch_id}: {e}")
+        return False
+
+def scan_conversations_by_status(statuses: Tuple[str, ...], company_id: Optional[str] = None,
+                                 project_id: Optional[str] = None, limit: Optional[int] = None) -> list | None:
+    """
+    Keys (primary_channel, conversation_id) of the conversations in one of
+    `statuses`, optionally of one company / project. A full table scan - for
+    bulk maintenance (batch_runner 'reprocess'), not per-record use.
+    """
+    if not conversations_table:
+        logger.error("DynamoDB conversations table not initialized. Cannot scan conversations.")
+        return None
+
+    names = {'#status': 'conversation_status'}
+    values = {f':s{i}': status for i, status in enumerate(statuses)}
+    conditions = [f"#status IN ({', '.join(values)})"]
+    for attribute, value in (('company_id', company_id), ('project_id', project_id)):
+        if value:
+            names[f'#{attribute}'] = attribute
+            values[f':{attribute}'] = value
+            conditions.append(f"#{attribute} = :{attribute}")
+    params = {
+        'FilterExpression': " AND ".join(conditions),
+        'ProjectionExpression': "primary_channel, conversation_id",
+        'ExpressionAttributeNames': names,
+        'ExpressionAttributeValues': values,
+    }
+    keys = []
+    try:
+        while True:
+            page = retry_policy.call('dynamodb.scan', conversations_table.scan, **params)
+            keys.extend({'primary_channel': item['primary_channel'], 'conversation_id': item['conversation_id']}
+                        for item in page.get('Items', []))
+            if (limit and len(keys) >= limit) or 'LastEvaluatedKey' not in page:
+                break
+            params['ExclusiveStartKey'] = page['LastEvaluatedKey']
+        return keys[:limit] if limit else keys
+    except Exception as e:
+        logger.exception(f"Error scanning conversations with status {statuses}: {e}")
+        return None
+
 # --- Cleanup Functions --- #
 
 def cleanup_staging_table(keys_to_delete: list[dict]) -> bool:
@@ -336,16 +707,9 @@ def cleanup_staging_table(keys_to_delete: list[dict]) -> bool:
     stage_table_name = conversations_stage_table.name
     logger.info(f"Attempting to batch delete {len(keys_to_delete)} items from {stage_table_name}")
 
-    # BatchWriteItem can handle up to 25 requests at a time
     try:
-        with conversations_stage_table.batch_writer() as batch:
-            for key in keys_to_delete:
-                # Ensure keys are present
-                if 'conversation_id' in key and 'message_sid' in key:
-                    batch.delete_item(Key=key)
-                else:
-                    logger.warning(f"Skipping invalid key in batch delete: {key}")
-        # batch_writer handles retries for unprocessed items automatically
+        # Deletes are idempotent, so a throttled batch is simply written again
+        retry_policy.call('dynamodb.batch_write_item', _delete_stage_items, keys_to_delete)
         logger.info(f"Batch delete submitted successfully for {stage_table_name}.")
         return True
     except ClientError as e:
@@ -355,37 +719,123 @@ def cleanup_staging_table(keys_to_delete: list[dict]) -> bool:
         logger.exception(f"Unexpected error during staging table cleanup: {e}")
         return False
 
-def cleanup_trigger_lock(conversation_id: str) -> bool:
+def _delete_stage_items(keys_to_delete: list[dict]) -> None:
+    """Deletes the keys with the table's batch_writer (25 per BatchWriteItem, unprocessed items resent)."""
+    with conversations_stage_table.batch_writer() as batch:
+        for key in keys_to_delete:
+            # Ensure keys are present
+            if 'conversation_id' in key and 'message_sid' in key:
+                batch.delete_item(Key=key)
+            else:
+                logger.warning(f"Skipping invalid key in batch delete: {key}")
+
+def is_outbox_item(item: Dict[str, Any]) -> bool:
+    """True for a reply outbox record returned by query_staging_table (not a message fragment)."""
+    return str(item.get('message_sid', '')).startswith(OUTBOX_SID_PREFIX)
+
+def outbox_key(conversation_id: str, first_message_sid: str) -> Dict[str, str]:
+    return {'conversation_id': conversation_id, 'message_sid': f"{OUTBOX_SID_PREFIX}{first_message_sid}"}
+
+def save_reply_outbox(conversation_id: str, first_message_sid: str, record: Dict[str, Any]) -> bool:
     """
-    Deletes the trigger lock item from the conversations-trigger-lock table.
+    Writes the reply outbox record of a batch (keyed by its first_message_sid) to
+    the stage table, replacing the previous checkpoint. A retried trigger reads it
+    with the fragments (query_staging_table) and resumes from it; cleanup_staging_table
+    removes it with them once the reply is stored.
+
+    Args:
+        record: 'stage' (OUTBOX_AI_COMPLETE or OUTBOX_SENT), the batch
+                ('combined_body', 'message_sids', 'primary_channel'), 'ai_response',
+                the reply parts already delivered ('sent') and, once sent, 'twilio_response'.
+
+    Returns:
+        True if the write succeeded, False otherwise.
+    """
+    if not conversations_stage_table:
+        logger.error("DynamoDB staging table object not initialized. Cannot save reply outbox.")
+        return False
+
+    now = int(time.time())
+    item = dict(record, **outbox_key(conversation_id, first_message_sid),
+                first_message_sid=first_message_sid, updated_at=now,
+                expires_at=now + REPLY_OUTBOX_TTL_SECONDS)
+    try:
+        # A full overwrite of the checkpoint - safe to repeat
+        retry_policy.call('dynamodb.put_item', dynamodb_lowlevel.put_item, dynamodb_client,
+                          conversations_stage_table.name, item)
+        logger.info(f"Saved reply outbox for {conversation_id}/{first_message_sid} (stage {record.get('stage')}).")
+        return True
+    except ClientError as e:
+        logger.error(f"DynamoDB ClientError saving reply outbox for {conversation_id}/{first_message_sid}: {e}")
+        return False
+    except Exception as e:
+        logger.exception(f"Unexpected error saving reply outbox for {conversation_id}/{first_message_sid}: {e}")
+        return False
+
+def cleanup_trigger_lock(conversation_id: str, batch_stats: Optional[Dict[str, int]] = None) -> bool:
+    """
+    Releases the trigger lock for a conversation.
+
+    Without batch_stats the lock item is deleted. With batch_stats the item is kept
+    (it carries the conversation's batch timing stats): the pending trigger marker is
+    removed and this batch's counters are added atomically.
 
     Args:
         conversation_id: The conversation ID (Partition Key).
+        batch_stats: Optional counters for the processed batch - 'fragment_count',
+                     'gap_sum_ms', 'gap_count' and 'last_fragment_at_ms'.
 
     Returns:
-        True if the delete was successful or the item didn't exist, False on error.
+        True if the delete/update was successful or the item didn't exist, False on error.
     """
     if not conversations_trigger_lock_table:
         logger.error("DynamoDB trigger lock table object not initialized. Cannot perform cleanup.")
         return False
 
     lock_table_name = conversations_trigger_lock_table.name
-    logger.info(f"Attempting to delete trigger lock for {conversation_id} from {lock_table_name}")
 
     try:
-        # Use DeleteItem - it succeeds even if the item doesn't exist
-        conversations_trigger_lock_table.delete_item(
+        if batch_stats is None:
+            logger.info(f"Attempting to delete trigger lock for {conversation_id} from {lock_table_name}")
+            # Use DeleteItem - it succeeds even if the item doesn't exist
+            retry_policy.call(
+                'dynamodb.delete_item', conversations_trigger_lock_table.delete_item,
+                Key={
+                    'conversation_id': conversation_id
+                }
+            )
+            logger.info(f"Successfully submitted delete request for trigger lock {conversation_id}.")
+            return True
+
+        logger.info(f"Releasing trigger lock and recording batch stats for {conversation_id} in {lock_table_name}: {batch_stats}")
+        update_expression = (
+            "REMOVE trigger_expires_at "
+            "SET expires_at = :exp, last_fragment_at_ms = :last "
+            "ADD batch_count :one, fragment_count :frags, gap_sum_ms :gap_sum, gap_count :gap_count"
+        )
+        # ADDs to the batch counters - only throttling errors are retried
+        retry_policy.call(
+            'dynamodb.update_item', conversations_trigger_lock_table.update_item, idempotent=False,
             Key={
                 'conversation_id': conversation_id
+            },
+            UpdateExpression=update_expression,
+            ExpressionAttributeValues={
+                ':exp': int(time.time()) + BATCH_STATS_TTL_SECONDS,
+                ':last': int(batch_stats.get('last_fragment_at_ms', 0)),
+                ':one': 1,
+                ':frags': int(batch_stats.get('fragment_count', 0)),
+                ':gap_sum': int(batch_stats.get('gap_sum_ms', 0)),
+                ':gap_count': int(batch_stats.get('gap_count', 0))
             }
         )
-        logger.info(f"Successfully submitted delete request for trigger lock {conversation_id}.")
+        logger.info(f"Successfully released trigger lock {conversation_id}.")
         return True
     except ClientError as e:
-        logger.error(f"DynamoDB ClientError deleting trigger lock for {conversation_id}: {e}")
+        logger.error(f"DynamoDB ClientError releasing trigger lock for {conversation_id}: {e}")
         return False
     except Exception as e:
-        logger.exception(f"Unexpected error deleting trigger lock for {conversation_id}: {e}")
+        logger.exception(f"Unexpected error releasing trigger lock for {conversation_id}: {e}")
         return False
 
 def release_lock_for_retry(primary_channel: str, conversation_id: str) -> bool:
@@ -406,7 +856,8 @@ def release_lock_for_retry(primary_channel: str, conversation_id: str) -> bool:
 
     logger.warning(f"Releasing lock for {primary_channel}/{conversation_id} by setting status to 'retry' due to processing error.")
     try:
-        conversations_table.update_item(
+        retry_policy.call(
+            'dynamodb.update_item', conversations_table.update_item,
             Key={
                 'primary_channel': primary_channel,
                 'conversation_id': conversation_id
@@ -426,3 +877,154 @@ def release_lock_for_retry(primary_channel: str, conversation_id: str) -> bool:
     except Exception as e:
         logger.exception(f"Unexpected error releasing lock (setting status to retry) for {primary_channel}/{conversation_id}: {e}")
         return False
+
+def _semaphore_key(company_id: str, project_id: str) -> Dict[str, str]:
+    return {'conversation_id': f"concurrency#{company_id}#{project_id}"}
+
+def acquire_concurrency_slot(company_id: str, project_id: str, holder_id: str, limit: int) -> str:
+    """
+    Takes one of `limit` concurrent-conversation slots for a company/project.
+
+    The semaphore is a single trigger-lock table item holding a map of
+    holder_id -> lease expiry (epoch seconds). Expired leases are dropped on every
+    acquisition, so a crashed invocation only holds its slot until the lease runs out.
+    Writes use optimistic concurrency on a version attribute.
+
+    Args:
+        company_id: Company the conversation belongs to.
+        project_id: Project the conversation belongs to.
+        holder_id: Identifies the holder (the conversation ID). Re-acquiring renews the lease.
+        limit: Maximum number of concurrent holders.
+
+    Returns:
+        str: SEMAPHORE_ACQUIRED, SEMAPHORE_FULL, or DB_ERROR.
+    """
+    if not conversations_trigger_lock_table:
+        logger.error("DynamoDB trigger lock table object not initialized. Cannot acquire concurrency slot.")
+        return DB_ERROR
+
+    key = _semaphore_key(company_id, project_id)
+    try:
+        for attempt in range(SEMAPHORE_MAX_ATTEMPTS):
+            now = int(time.time())
+            item = retry_policy.call(
+                'dynamodb.get_item', conversations_trigger_lock_table.get_item, Key=key, ConsistentRead=True
+            ).get('Item') or {}
+            holders = {holder: int(expiry) for holder, expiry in item.get('holders', {}).items() if int(expiry) > now}
+
+            if holder_id not in holders and len(holders) >= limit:
+                logger.info(f"Concurrency limit reached for {key['conversation_id']}: {len(holders)}/{limit} slots in use")
+                return SEMAPHORE_FULL
+
+            holders[holder_id] = now + CONCURRENCY_LEASE_SECONDS
+            version = int(item.get('version', 0))
+            try:
+                retry_policy.call(
+                    'dynamodb.update_item', conversations_trigger_lock_table.update_item, idempotent=False,
+                    Key=key,
+                    UpdateExpression="SET holders = :holders, version = :new_version, expires_at = :exp",
+                    ConditionExpression="attribute_not_exists(version) OR version = :version",
+                    ExpressionAttributeValues={
+                        ':holders': holders,
+                        ':new_version': version + 1,
+                        ':version': version,
+                        ':exp': now + CONCURRENCY_LEASE_SECONDS
+                    }
+                )
+                logger.info(f"Acquired concurrency slot on {key['conversation_id']} for {holder_id} ({len(holders)}/{limit})")
+                return SEMAPHORE_ACQUIRED
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+                logger.info(f"Concurrent update of {key['conversation_id']} (attempt {attempt + 1}), retrying")
+
+        # Heavy contention means the semaphore is busy - treat it as full so the record is deferred
+        logger.warning(f"Gave up acquiring concurrency slot on {key['conversation_id']} after {SEMAPHORE_MAX_ATTEMPTS} attempts")
+        return SEMAPHORE_FULL
+
+    except ClientError as e:
+        logger.exception(f"DynamoDB ClientError acquiring concurrency slot on {key['conversation_id']}: {e}")
+        return DB_ERROR
+    except Exception as e:
+        logger.exception(f"Unexpected error acquiring concurrency slot on {key['conversation_id']}: {e}")
+        return DB_ERROR
+
+def release_concurrency_slot(company_id: str, project_id: str, holder_id: str) -> bool:
+    """
+    Gives back a slot taken with acquire_concurrency_slot. Bumps the version so
+    in-flight optimistic acquisitions re-read the holder map.
+
+    Returns:
+        True if released (or not held), False on error. The lease expiry covers failures.
+    """
+    if not conversations_trigger_lock_table:
+        logger.error("DynamoDB trigger lock table object not initialized. Cannot release concurrency slot.")
+        return False
+
+    key = _semaphore_key(company_id, project_id)
+    try:
+        retry_policy.call(
+            'dynamodb.update_item', conversations_trigger_lock_table.update_item, idempotent=False,
+            Key=key,
+            UpdateExpression="REMOVE holders.#holder SET version = version + :one",
+            ConditionExpression="attribute_exists(holders)",
+            ExpressionAttributeNames={'#holder': holder_id},
+            ExpressionAttributeValues={':one': 1}
+        )
+        logger.info(f"Released concurrency slot on {key['conversation_id']} for {holder_id}")
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            logger.info(f"No concurrency semaphore item {key['conversation_id']} to release")
+            return True
+        logger.error(f"DynamoDB ClientError releasing concurrency slot on {key['conversation_id']}: {e}")
+        return False
+    except Exception as e:
+        logger.exception(f"Unexpected error releasing concurrency slot on {key['conversation_id']}: {e}")
+        return False
+
+def reserve_send_tokens(counter_key: str, amount: int, limit: int, expires_at: int) -> Dict[str, Any]:
+    """
+    Atomically adds `amount` sends to a per-sender, per-second counter
+    (core/sender_rate_limiter.py), unless that would take it past `limit`.
+
+    Counter items live in the trigger-lock table under a 'sendrate#...' key and are
+    removed by the table's TTL once their second has passed.
+
+    Returns:
+        dict: {'status': 'RESERVED', 'count': new_count} on success,
+              {'status': 'LIMIT_EXCEEDED'} if the reservation does not fit,
+              {'status': DB_ERROR} on failure.
+    """
+    if not conversations_trigger_lock_table:
+        logger.error("DynamoDB trigger lock table object not initialized. Cannot reserve send tokens.")
+        return {'status': DB_ERROR}
+    if not counter_key or amount < 1 or amount > limit:
+        logger.error(f"reserve_send_tokens called with invalid arguments: key='{counter_key}', amount={amount}, limit={limit}")
+        return {'status': DB_ERROR}
+
+    try:
+        response = retry_policy.call(
+            'dynamodb.update_item', conversations_trigger_lock_table.update_item, idempotent=False,
+            Key={'conversation_id': counter_key},
+            UpdateExpression='SET expires_at = if_not_exists(expires_at, :exp) ADD send_count :n',
+            ConditionExpression='attribute_not_exists(send_count) OR send_count <= :max_before',
+            ExpressionAttributeValues={
+                ':n': amount,
+                ':max_before': limit - amount,
+                ':exp': expires_at
+            },
+            ReturnValues='UPDATED_NEW'
+        )
+        count = int(response.get('Attributes', {}).get('send_count', amount))
+        logger.debug(f"Reserved {amount} send tokens on {counter_key} (count now {count}/{limit})")
+        return {'status': 'RESERVED', 'count': count}
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            logger.info(f"Send counter {counter_key} cannot take {amount} more messages (limit {limit})")
+            return {'status': 'LIMIT_EXCEEDED'}
+        logger.error(f"DynamoDB ClientError updating send counter {counter_key}: {e}")
+        return {'status': DB_ERROR}
+    except Exception as e:
+        logger.exception(f"Unexpected error updating send counter {counter_key}: {e}")
+        return {'status': DB_ERROR}
@@ -1,12 +1,13 @@
 # services/secrets_manager_service.py - Messaging Lambda (WhatsApp)
 
-import boto3
 import json
 import logging
 import os
 from botocore.exceptions import ClientError
 from typing import Dict, Any, Optional, Tuple # Added Tuple
 
+from ..utils import aws_clients, retry_policy
+
 logger = logging.getLogger(__name__)
 logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
 
@@ -25,10 +26,9 @@ def _get_secrets_manager_client():
     """Initializes and returns the Secrets Manager client."""
     global secrets_manager
     if secrets_manager is None:
-        region = os.environ.get('AWS_REGION', 'eu-north-1')
-        logger.info(f"Initializing Secrets Manager client in region: {region}")
+        logger.info(f"Initializing Secrets Manager client in region: {aws_clients.AWS_REGION}")
         try:
-            secrets_manager = boto3.client('secretsmanager', region_name=region)
+            secrets_manager = aws_clients.client('secretsmanager')
         except Exception as e:
              logger.critical(f"Failed to initialize secrets manager client: {e}")
              raise RuntimeError(f"Secrets Manager client init failed: {e}") # Raise custom error
@@ -59,7 +59,7 @@ def get_secret(secret_id: str) -> Tuple[str, Optional[Dict[str, Any]]]:
 
     logger.info(f"Attempting to retrieve secret: {secret_id}")
     try:
-        get_secret_value_response = client.get_secret_value(SecretId=secret_id)
+        get_secret_value_response = retry_policy.call('secretsmanager.get_secret_value', client.get_secret_value, SecretId=secret_id)
         logger.debug(f"Successfully called GetSecretValue for: {secret_id}")
 
         if 'SecretString' in get_secret_value_response:
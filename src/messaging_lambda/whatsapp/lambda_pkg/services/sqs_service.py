@@ -0,0 +1,187 @@
+# services/sqs_service.py - Messaging Lambda (WhatsApp)
+
+import os
+import json
+import hashlib
+import logging
+from botocore.exceptions import ClientError
+
+from ..utils import aws_clients, retry_policy
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+
+# Status constants for return values
+SQS_DEFERRED = "DEFERRED"   # Visibility extended - leave the message on the queue (report it as a batch item failure)
+SQS_REQUEUED = "REQUEUED"   # A delayed copy was sent - the original can be deleted
+SQS_ERROR = "SQS_ERROR"
+SQS_SENT = "SENT"
+
+# SQS hard limits
+SQS_MAX_DELAY_SECONDS = 900
+SQS_MAX_VISIBILITY_SECONDS = 43200
+SQS_BATCH_LIMIT = 10                # messages per ReceiveMessage / DeleteMessageBatch
+SQS_MAX_MESSAGE_BYTES = 262144
+FIFO_MAX_ID_LENGTH = 128
+
+# Records received this many times are re-sent instead of having their visibility
+# extended, so repeated deferrals never count towards the queue's maxReceiveCount
+DEFER_REQUEUE_RECEIVE_COUNT = int(os.environ.get('DEFER_REQUEUE_RECEIVE_COUNT', '2'))
+
+sqs = None
+try:
+    sqs = aws_clients.client('sqs')
+    logger.info("SQS client initialized.")
+except Exception as e:
+    logger.critical(f"Failed to initialize SQS client: {e}")
+    sqs = None
+
+def is_fifo_queue(queue_url: str) -> bool:
+    """FIFO queue names (and so their URLs) end in '.fifo'."""
+    return bool(queue_url) and queue_url.endswith('.fifo')
+
+def defer_message(queue_url: str, receipt_handle: str, body: str, receive_count: int, delay_seconds: int) -> str:
+    """
+    Puts an SQS message back for `delay_seconds` without counting it as a failure.
+
+    Normally this extends the message's visibility timeout. Once the message has been
+    received DEFER_REQUEUE_RECEIVE_COUNT times, a fresh copy is sent with DelaySeconds
+    instead (its receive count starts again at zero) and the caller deletes the original.
+    FIFO queues take no per-message DelaySeconds, so there it is always the visibility
+    timeout - the record's message group stays blocked until it reappears.
+
+    Args:
+        queue_url: The queue the message came from.
+        receipt_handle: The receipt handle of the current receive.
+        body: The message body, used for the re-sent copy.
+        receive_count: The record's ApproximateReceiveCount.
+        delay_seconds: How long to hide the message for.
+
+    Returns:
+        str: SQS_DEFERRED, SQS_REQUEUED, or SQS_ERROR.
+    """
+    if not sqs:
+        logger.error("SQS client not initialized. Cannot defer message.")
+        return SQS_ERROR
+
+    try:
+        if receive_count >= DEFER_REQUEUE_RECEIVE_COUNT and body and not is_fifo_queue(queue_url):
+            retry_policy.call(
+                'sqs.send_message', sqs.send_message,
+                QueueUrl=queue_url,
+                MessageBody=body,
+                DelaySeconds=max(0, min(int(delay_seconds), SQS_MAX_DELAY_SECONDS))
+            )
+            logger.info(f"Re-queued message with {delay_seconds}s delay (receive count {receive_count})")
+            return SQS_REQUEUED
+
+        if not receipt_handle:
+            logger.error("Missing receipt handle. Cannot extend visibility.")
+            return SQS_ERROR
+        retry_policy.call(
+            'sqs.change_message_visibility', sqs.change_message_visibility,
+            QueueUrl=queue_url,
+            ReceiptHandle=receipt_handle,
+            VisibilityTimeout=max(0, min(int(delay_seconds), SQS_MAX_VISIBILITY_SECONDS))
+        )
+        logger.info(f"Deferred message by {delay_seconds}s via visibility timeout")
+        return SQS_DEFERRED
+
+    except ClientError as e:
+        logger.error(f"SQS ClientError deferring message on {queue_url}: {e}")
+        return SQS_ERROR
+    except Exception as e:
+        logger.exception(f"Unexpected error deferring message on {queue_url}: {e}")
+        return SQS_ERROR
+
+def _fifo_id(value: str) -> str:
+    """A MessageGroupId / MessageDeduplicationId within SQS's length limit."""
+    return value if len(value) <= FIFO_MAX_ID_LENGTH else hashlib.sha256(value.encode('utf-8')).hexdigest()
+
+def send_message(queue_url: str, body: dict, group_id: str = None, deduplication_id: str = None) -> str:
+    """
+    Sends a JSON message. On a FIFO queue, group_id (and deduplication_id) are
+    required: the conversation's message group, as the staging Lambda sends triggers.
+
+    Returns:
+        str: SQS_SENT or SQS_ERROR (including bodies over SQS's size limit).
+    """
+    if not sqs:
+        logger.error("SQS client not initialized. Cannot send message.")
+        return SQS_ERROR
+
+    message_body = json.dumps(body)
+    if len(message_body.encode('utf-8')) > SQS_MAX_MESSAGE_BYTES:
+        logger.error(f"Message of {len(message_body)} chars is over the SQS size limit for {queue_url}.")
+        return SQS_ERROR
+    params = {}
+    if is_fifo_queue(queue_url):
+        params = {'MessageGroupId': _fifo_id(group_id), 'MessageDeduplicationId': _fifo_id(deduplication_id or group_id)}
+    try:
+        # Consumers tolerate SQS's at-least-once delivery, so a repeated send is safe
+        retry_policy.call('sqs.send_message', sqs.send_message, QueueUrl=queue_url, MessageBody=message_body, **params)
+        return SQS_SENT
+    except ClientError as e:
+        logger.error(f"SQS ClientError sending message to {queue_url}: {e}")
+        return SQS_ERROR
+    except Exception as e:
+        logger.exception(f"Unexpected error sending message to {queue_url}: {e}")
+        return SQS_ERROR
+
+def receive_messages(queue_url: str, max_messages: int, visibility_timeout: int = None) -> list | None:
+    """
+    Receives up to max_messages visible messages without waiting (several
+    ReceiveMessage calls of up to 10). Returns [(receipt_handle, body dict)],
+    or None if the first receive failed. Unreadable bodies are skipped and
+    left to the queue's redrive policy.
+    """
+    if not sqs:
+        logger.error("SQS client not initialized. Cannot receive messages.")
+        return None
+
+    params = {'QueueUrl': queue_url, 'WaitTimeSeconds': 0}
+    if visibility_timeout is not None:
+        params['VisibilityTimeout'] = max(0, min(int(visibility_timeout), SQS_MAX_VISIBILITY_SECONDS))
+    messages = []
+    while len(messages) < max_messages:
+        try:
+            received = retry_policy.call(
+                'sqs.receive_message', sqs.receive_message,
+                MaxNumberOfMessages=min(SQS_BATCH_LIMIT, max_messages - len(messages)), **params
+            ).get('Messages', [])
+        except Exception as e:
+            logger.exception(f"Error receiving messages from {queue_url}: {e}")
+            if not messages:
+                return None
+            break
+        if not received:
+            break
+        for message in received:
+            try:
+                messages.append((message['ReceiptHandle'], json.loads(message['Body'])))
+            except (KeyError, ValueError):
+                logger.error(f"Skipping unreadable message {message.get('MessageId')} on {queue_url}.")
+    return messages
+
+def delete_messages(queue_url: str, receipt_handles: list) -> bool:
+    """Deletes messages with DeleteMessageBatch (10 per call). True if every delete succeeded."""
+    if not sqs:
+        logger.error("SQS client not initialized. Cannot delete messages.")
+        return False
+
+    success = True
+    for start in range(0, len(receipt_handles), SQS_BATCH_LIMIT):
+        chunk = receipt_handles[start:start + SQS_BATCH_LIMIT]
+        try:
+            response = retry_policy.call(
+                'sqs.delete_message_batch', sqs.delete_message_batch,
+                QueueUrl=queue_url,
+                Entries=[{'Id': str(n), 'ReceiptHandle': handle} for n, handle in enumerate(chunk)]
+            )
+            if response.get('Failed'):
+                logger.error(f"{len(response['Failed'])} deletes failed on {queue_url}: {response['Failed']}")
+                success = False
+        except Exception as e:
+            logger.exception(f"Error deleting {len(chunk)} messages from {queue_url}: {e}")
+            success = False
+    return success
@@ -2,9 +2,11 @@
 
 import logging
 import os
-from typing import Dict, Any, Optional, Tuple
+import threading
+from typing import Callable, Dict, Any, List, Optional, Tuple
 
 from twilio.rest import Client
+from twilio.http.http_client import TwilioHttpClient
 from twilio.base.exceptions import TwilioRestException
 
 logger = logging.getLogger(__name__)
@@ -17,47 +19,51 @@ TWILIO_NON_TRANSIENT_ERROR = "NON_TRANSIENT_ERROR" # Auth, Invalid number, Bad r
 TWILIO_INVALID_INPUT = "INVALID_INPUT" # Missing args to this function
 # --- End Status Codes --- #
 
-def send_whatsapp_reply(
-    twilio_creds: Dict[str, str],
-    recipient_number: str,
-    sender_number: str,
-    message_body: str
-) -> Tuple[str, Optional[Dict[str, Any]]]:
-    """
-    Sends a standard WhatsApp message via the Twilio API.
+# Reuse one pooled HTTP session per container, so later messages (and the later parts
+# of a split reply) skip the TCP/TLS handshake
+TWILIO_POOL_CONNECTIONS = os.environ.get('TWILIO_POOL_CONNECTIONS', 'true').lower() == 'true'
+# Paced sends (see `pace` below) are retried this many times after a 429 (Too Many Requests)
+TWILIO_RATE_LIMIT_RETRIES = int(os.environ.get('TWILIO_RATE_LIMIT_RETRIES', '2'))
 
-    Args:
-        twilio_creds: Dict containing 'twilio_account_sid' and 'twilio_auth_token'.
-        recipient_number: The user's phone number (e.g., +1...). No prefix needed.
-        sender_number: The company's Twilio WhatsApp number (e.g., +1...). No prefix needed.
-        message_body: The text content of the message to send.
+_http_client = None
+_http_client_lock = threading.Lock()
 
-    Returns:
-        A tuple containing:
-        - status_code (str): One of the TWILIO_* status constants.
-        - result (Optional[Dict]): On SUCCESS, contains {'message_sid': str, 'body': str}.
-                                   On failure, contains {'error_message': str} or None.
-    """
-    account_sid = twilio_creds.get('twilio_account_sid')
-    auth_token = twilio_creds.get('twilio_auth_token')
-
-    if not all([account_sid, auth_token, recipient_number, sender_number, message_body]):
-        error_msg = "Missing required arguments for Twilio send_whatsapp_reply."
-        logger.error(error_msg)
-        return TWILIO_INVALID_INPUT, {"error_message": error_msg}
 
-    # Add whatsapp: prefix
-    formatted_recipient = f"whatsapp:{recipient_number}"
-    formatted_sender = f"whatsapp:{sender_number}"
+def _client(account_sid: str, auth_token: str):
+    """A Twilio client for the account, on the container's pooled HTTP session."""
+    global _http_client
+    if not TWILIO_POOL_CONNECTIONS:
+        return Client(account_sid, auth_token)
+    with _http_client_lock:
+        if _http_client is None:
+            _http_client = TwilioHttpClient(pool_connections=True)
+    return Client(account_sid, auth_token, http_client=_http_client)
 
-    logger.info(f"Attempting to send WhatsApp reply via Twilio.")
-    logger.debug(f"  To: {formatted_recipient}")
-    logger.debug(f"  From: {formatted_sender}")
-    logger.debug(f"  Body: {message_body[:100]}...") # Log snippet
 
+def _create_message(client, formatted_sender: str, formatted_recipient: str, message_body: str,
+                    pace: Optional[Callable[..., bool]] = None) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """
+    One message, with Twilio errors mapped to TWILIO_* statuses. With `pace`
+    (core/sender_rate_limiter.py), each attempt first waits for a send slot, and a
+    429 is retried (pace(throttled=True)) up to TWILIO_RATE_LIMIT_RETRIES times.
+    """
+    attempts = 1 + (TWILIO_RATE_LIMIT_RETRIES if pace else 0)
+    for attempt in range(attempts):
+        if pace and not pace(throttled=attempt > 0):
+            return TWILIO_TRANSIENT_ERROR, {"error_message": "No send slot free for the sender within the wait budget.",
+                                            "rate_limited": True}
+        status, payload = _create_message_once(client, formatted_sender, formatted_recipient, message_body)
+        if not (payload or {}).get('rate_limited'):
+            break
+        if attempt + 1 < attempts:
+            logger.warning(f"Twilio rate limited {formatted_sender}; retrying once a send slot is free (attempt {attempt + 2}/{attempts})")
+    return status, payload
+
+
+def _create_message_once(client, formatted_sender: str, formatted_recipient: str,
+                         message_body: str) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """One messages.create call."""
     try:
-        client = Client(account_sid, auth_token)
-
         message = client.messages.create(
             from_=formatted_sender,
             to=formatted_recipient,
@@ -78,7 +84,10 @@ def send_whatsapp_reply(
         logger.error(error_msg)
         # Basic mapping: 4xx errors are non-transient, 5xx are transient
         # See: https://www.twilio.com/docs/api/errors
-        if 400 <= e.status < 500:
+        if e.status == 429 or e.code == 20429:
+            # Too Many Requests (sender throughput) - the message was not accepted, retry later
+            return TWILIO_TRANSIENT_ERROR, {"error_message": error_msg, "rate_limited": True}
+        elif 400 <= e.status < 500:
              # e.g., 21211 (Invalid 'To'), 21606 (From number not capable), 
              # 21408 (Permission denied), 20003 (Auth error), 21614 (Not registered number)
              # 63016 (Failed to send message - often permanent like blocked number)
@@ -96,4 +105,98 @@ def send_whatsapp_reply(
         error_msg = f"Unexpected error sending message via Twilio: {e}"
         logger.exception(error_msg)
         # Assume unexpected errors are potentially transient for retry
-        return TWILIO_TRANSIENT_ERROR, {"error_message": error_msg} 
\ No newline at end of file
+        return TWILIO_TRANSIENT_ERROR, {"error_message": error_msg}
+
+
+def send_whatsapp_reply(
+    twilio_creds: Dict[str, str],
+    recipient_number: str,
+    sender_number: str,
+    message_body: str,
+    pace: Optional[Callable[..., bool]] = None
+) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """
+    Sends a standard WhatsApp message via the Twilio API.
+
+    Args:
+        twilio_creds: Dict containing 'twilio_account_sid' and 'twilio_auth_token'.
+        recipient_number: The user's phone number (e.g., +1...). No prefix needed.
+        sender_number: The company's Twilio WhatsApp number (e.g., +1...). No prefix needed.
+        message_body: The text content of the message to send.
+        pace: Optional sender rate limiter, called before each attempt
+              (core/sender_rate_limiter.acquire bound to the sender).
+
+    Returns:
+        A tuple containing:
+        - status_code (str): One of the TWILIO_* status constants.
+        - result (Optional[Dict]): On SUCCESS, contains {'message_sid': str, 'body': str}.
+                                   On failure, contains {'error_message': str} or None
+                                   ('rate_limited': True for a 429, or no free send slot).
+    """
+    account_sid = twilio_creds.get('twilio_account_sid')
+    auth_token = twilio_creds.get('twilio_auth_token')
+
+    if not all([account_sid, auth_token, recipient_number, sender_number, message_body]):
+        error_msg = "Missing required arguments for Twilio send_whatsapp_reply."
+        logger.error(error_msg)
+        return TWILIO_INVALID_INPUT, {"error_message": error_msg}
+
+    # Add whatsapp: prefix
+    formatted_recipient = f"whatsapp:{recipient_number}"
+    formatted_sender = f"whatsapp:{sender_number}"
+
+    logger.info(f"Attempting to send WhatsApp reply via Twilio.")
+    logger.debug(f"  To: {formatted_recipient}")
+    logger.debug(f"  From: {formatted_sender}")
+    logger.debug(f"  Body: {message_body[:100]}...") # Log snippet
+
+    client = _client(account_sid, auth_token)
+    return _create_message(client, formatted_sender, formatted_recipient, message_body, pace)
+
+
+def send_whatsapp_parts(
+    twilio_creds: Dict[str, str],
+    recipient_number: str,
+    sender_number: str,
+    parts: List[str],
+    pace: Optional[Callable[..., bool]] = None
+) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """
+    Sends a reply split into several WhatsApp messages (core/reply_composer.py),
+    one after another in order, over one client. Stops at the first failure.
+    `pace` is applied to every part, as for send_whatsapp_reply.
+
+    Returns:
+        A tuple containing:
+        - status_code (str): One of the TWILIO_* status constants.
+        - result (Optional[Dict]): On SUCCESS, {'message_sid': first part's SID,
+          'body': the parts joined by blank lines, 'message_sids': [...]}.
+          On failure, {'error_message': str, 'sent': [payloads of the parts
+          already delivered]}.
+    """
+    account_sid = twilio_creds.get('twilio_account_sid')
+    auth_token = twilio_creds.get('twilio_auth_token')
+
+    if not all([account_sid, auth_token, recipient_number, sender_number]) or not parts or not all(parts):
+        error_msg = "Missing required arguments for Twilio send_whatsapp_parts."
+        logger.error(error_msg)
+        return TWILIO_INVALID_INPUT, {"error_message": error_msg, "sent": []}
+
+    formatted_recipient = f"whatsapp:{recipient_number}"
+    formatted_sender = f"whatsapp:{sender_number}"
+    logger.info(f"Attempting to send a WhatsApp reply in {len(parts)} parts via Twilio.")
+
+    client = _client(account_sid, auth_token)
+    sent = []
+    for number, part in enumerate(parts, start=1):
+        status, payload = _create_message(client, formatted_sender, formatted_recipient, part, pace)
+        if status != TWILIO_SUCCESS:
+            logger.error(f"Sending part {number}/{len(parts)} failed ({status}) after {len(sent)} part(s) were delivered.")
+            return status, dict(payload or {}, sent=sent)
+        sent.append(payload)
+
+    return TWILIO_SUCCESS, {
+        "message_sid": sent[0]['message_sid'],
+        "body": '\n\n'.join(part['body'] for part in sent),
+        "message_sids": [part['message_sid'] for part in sent]
+    }
@@ -0,0 +1,254 @@
+# utils/metrics.py - Messaging Lambda (WhatsApp)
+
+"""
+Stage timing metrics emitted as CloudWatch Embedded Metric Format (EMF).
+
+Timings are collected in memory while a request is processed and written out
+once per invocation by flush(). In Lambda the default sink prints EMF JSON to
+stdout, which CloudWatch Logs turns into metrics without any API calls.
+Tests and local benchmarks swap in a MemorySink to capture the same numbers.
+
+Usage:
+    @metrics.flush_after_invocation
+    def handler(event, context):
+        metrics.begin_scope(channel='whatsapp')   # one scope per SQS record
+        with metrics.timer('parse'):
+            ...
+        metrics.set_dimensions(company_id='ci-aaa-000')   # applies to the whole scope
+"""
+
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+
+# --- Configuration ---
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'AIMultiComms/RepliesEngine')
+SERVICE_NAME = os.environ.get('METRICS_SERVICE_NAME', 'WhatsAppMessagingLambda')
+
+UNIT_MILLISECONDS = 'Milliseconds'
+UNIT_COUNT = 'Count'
+
+# Dimension keys in the EMF document, in declaration order
+DIMENSION_KEYS = ('Service', 'Channel', 'CompanyId')
+_DIMENSION_ARGS = {'channel': 'Channel', 'company_id': 'CompanyId'}
+# Dimension sets published per document: per channel+company, and a per-service rollup
+DIMENSION_SETS = [list(DIMENSION_KEYS), ['Service']]
+
+# EMF allows at most 100 values per metric per document
+MAX_VALUES_PER_METRIC = 100
+UNKNOWN = 'unknown'
+
+
+# --- Sinks ---
+
+class StdoutSink:
+    """Writes each EMF document as a single JSON line (picked up by CloudWatch Logs)."""
+
+    def emit(self, document):
+        print(json.dumps(document, separators=(',', ':')), flush=True)
+
+
+class MemorySink:
+    """Keeps emitted EMF documents in memory for tests and benchmarks."""
+
+    def __init__(self):
+        self.documents = []
+        self._lock = threading.Lock()
+
+    def emit(self, document):
+        with self._lock:
+            self.documents.append(document)
+
+    def clear(self):
+        with self._lock:
+            self.documents = []
+
+    def values(self, metric_name, **dimensions):
+        """Returns every recorded value of a metric, optionally filtered by dimension (e.g. channel='sms')."""
+        wanted = {_DIMENSION_ARGS.get(k, k): v for k, v in dimensions.items()}
+        collected = []
+        with self._lock:
+            documents = list(self.documents)
+        for document in documents:
+            if any(document.get(k) != v for k, v in wanted.items()):
+                continue
+            value = document.get(metric_name)
+            if value is None:
+                continue
+            collected.extend(value if isinstance(value, list) else [value])
+        return collected
+
+
+_sink = StdoutSink()
+_state = threading.local()
+
+
+def set_sink(sink):
+    """Replaces the output sink. Returns the previous one so callers can restore it."""
+    global _sink
+    previous = _sink
+    _sink = sink
+    return previous
+
+
+def get_sink():
+    return _sink
+
+
+# --- Recording ---
+
+def _scopes():
+    if not hasattr(_state, 'scopes'):
+        _state.scopes = []
+    return _state.scopes
+
+
+def _current_scope():
+    scopes = _scopes()
+    if not scopes:
+        scopes.append({'dimensions': {}, 'metrics': {}})
+    return scopes[-1]
+
+
+def begin_scope(**dimensions):
+    """
+    Starts a new dimension scope within the current invocation (e.g. one SQS record).
+    Metrics recorded afterwards are tagged with this scope's dimensions.
+    """
+    _scopes().append({'dimensions': {}, 'metrics': {}})
+    set_dimensions(**dimensions)
+
+
+def set_dimensions(**dimensions):
+    """Sets channel / company_id for the current scope. None values are ignored."""
+    scope = _current_scope()
+    for key, value in dimensions.items():
+        if value is None:
+            continue
+        name = _DIMENSION_ARGS.get(key)
+        if name is None:
+            logger.warning(f"Ignoring unsupported metric dimension '{key}'")
+            continue
+        scope['dimensions'][name] = str(value)
+
+
+def put_metric(name, value, unit=UNIT_MILLISECONDS):
+    """Records a single metric value in the current scope."""
+    if not METRICS_ENABLED:
+        return
+    try:
+        entry = _current_scope()['metrics'].setdefault(name, {'unit': unit, 'values': []})
+        entry['values'].append(value)
+    except Exception:
+        logger.exception(f"Failed to record metric '{name}'")
+
+
+@contextmanager
+def timer(stage):
+    """Times the enclosed block and records it as '<stage>' in milliseconds (also on exceptions)."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        put_metric(stage, round((time.perf_counter() - start) * 1000.0, 3))
+
+
+def snapshot():
+    """
+    Returns the not-yet-flushed values aggregated across scopes:
+    {metric_name: {'count', 'sum', 'min', 'max'}}. Useful for benchmarks.
+    """
+    summary = {}
+    for scope in _scopes():
+        for name, entry in scope['metrics'].items():
+            values = entry['values']
+            if not values:
+                continue
+            agg = summary.setdefault(name, {'count': 0, 'sum': 0.0, 'min': None, 'max': None})
+            agg['count'] += len(values)
+            agg['sum'] += sum(values)
+            agg['min'] = min(values) if agg['min'] is None else min(agg['min'], min(values))
+            agg['max'] = max(values) if agg['max'] is None else max(agg['max'], max(values))
+    return summary
+
+
+def _build_documents(dimensions, metrics_by_name, timestamp_ms):
+    """Builds EMF documents for one dimension combination, chunking metrics over 100 values."""
+    documents = []
+    chunk = 0
+    while True:
+        document_metrics = {}
+        for name, entry in metrics_by_name.items():
+            values = entry['values'][chunk * MAX_VALUES_PER_METRIC:(chunk + 1) * MAX_VALUES_PER_METRIC]
+            if values:
+                document_metrics[name] = (entry['unit'], values)
+        if not document_metrics:
+            break
+        document = {
+            '_aws': {
+                'Timestamp': timestamp_ms,
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': DIMENSION_SETS,
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, (unit, _) in document_metrics.items()]
+                }]
+            }
+        }
+        document.update(dimensions)
+        for name, (_, values) in document_metrics.items():
+            document[name] = values if len(values) > 1 else values[0]
+        documents.append(document)
+        chunk += 1
+    return documents
+
+
+def flush():
+    """
+    Emits everything recorded in this invocation (one document per dimension
+    combination) and clears the buffer. Never raises.
+    """
+    scopes = _scopes()
+    _state.scopes = []
+    if not METRICS_ENABLED or not scopes:
+        return
+
+    try:
+        # Merge scopes that ended up with the same dimensions
+        grouped = {}
+        for scope in scopes:
+            dimensions = {
+                'Service': SERVICE_NAME,
+                'Channel': scope['dimensions'].get('Channel', UNKNOWN),
+                'CompanyId': scope['dimensions'].get('CompanyId', UNKNOWN)
+            }
+            key = tuple(dimensions[k] for k in DIMENSION_KEYS)
+            target = grouped.setdefault(key, (dimensions, {}))[1]
+            for name, entry in scope['metrics'].items():
+                target.setdefault(name, {'unit': entry['unit'], 'values': []})['values'].extend(entry['values'])
+
+        timestamp_ms = int(time.time() * 1000)
+        for dimensions, metrics_by_name in grouped.values():
+            for document in _build_documents(dimensions, metrics_by_name, timestamp_ms):
+                _sink.emit(document)
+    except Exception:
+        logger.exception("Failed to flush metrics")
+
+
+def flush_after_invocation(func):
+    """Decorator for Lambda handlers: starts a fresh buffer and flushes it when the handler returns or raises."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        _state.scopes = []
+        try:
+            return func(*args, **kwargs)
+        finally:
+            flush()
+    return wrapper
@@ -0,0 +1,172 @@
+# utils/retry_policy.py - Messaging Lambda (WhatsApp)
+
+"""
+In-process retries for transient AWS errors, so a throttled call is retried
+inside the invocation instead of failing the whole SQS record (which means a
+redelivery after the visibility timeout and another count towards maxReceiveCount).
+
+Service modules wrap their boto3 calls:
+
+    item = retry_policy.call('dynamodb.get_item', conversations_table.get_item, Key=...).get('Item')
+
+A ClientError is retried when its code is in THROTTLING_ERROR_CODES, or - for
+calls marked idempotent - SERVER_ERROR_CODES. Conditional or counter writes
+pass idempotent=False: a throttled request was never applied, but one that
+failed with a 500 may have been, and repeating it could trip its own condition.
+
+Each retry waits a decorrelated-jitter backoff
+(sleep = min(RETRY_MAX_DELAY_MS, uniform(RETRY_BASE_DELAY_MS, previous sleep * 3)))
+and is only taken if:
+
+    - the operation has attempts left (MAX_ATTEMPTS, by '<service>.<operation>' or '<service>')
+    - the invocation's retry budget (RETRY_BUDGET_PER_INVOCATION) is not spent, so
+      retries cannot multiply load during an outage
+    - the sleep still leaves RETRY_DEADLINE_MARGIN_MS of the invocation's remaining time
+
+Otherwise the last error is re-raised and the caller maps it to its
+*_TRANSIENT_ERROR status as before. The budget and deadline are reset per
+invocation by the @retry_policy.per_invocation handler decorator. They are
+kept per thread, so concurrent invocations in one container (the messaging
+worker's shard threads) each keep their own.
+"""
+
+import functools
+import logging
+import os
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+
+# --- Configuration ---
+RETRY_ENABLED = os.environ.get('RETRY_ENABLED', 'true').lower() == 'true'
+RETRY_BASE_DELAY_MS = int(os.environ.get('RETRY_BASE_DELAY_MS', '25'))
+RETRY_MAX_DELAY_MS = int(os.environ.get('RETRY_MAX_DELAY_MS', '1000'))
+RETRY_BUDGET_PER_INVOCATION = int(os.environ.get('RETRY_BUDGET_PER_INVOCATION', '6'))
+RETRY_DEADLINE_MARGIN_MS = int(os.environ.get('RETRY_DEADLINE_MARGIN_MS', '1000'))
+
+# Attempts per call, first try included
+MAX_ATTEMPTS = {
+    'dynamodb': int(os.environ.get('RETRY_DYNAMODB_MAX_ATTEMPTS', '3')),
+    'sqs': int(os.environ.get('RETRY_SQS_MAX_ATTEMPTS', '3')),
+    'secretsmanager': int(os.environ.get('RETRY_SECRETS_MAX_ATTEMPTS', '2')),
+    's3': int(os.environ.get('RETRY_S3_MAX_ATTEMPTS', '3')),
+}
+DEFAULT_MAX_ATTEMPTS = 2
+
+# The request was rejected before it was applied - safe to repeat any call
+THROTTLING_ERROR_CODES = {
+    'ProvisionedThroughputExceededException',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+    'RequestThrottled',
+    'Throttling',
+    'TooManyRequestsException',
+    'SlowDown', # S3
+}
+# The service failed - the request may or may not have been applied
+SERVER_ERROR_CODES = {
+    'InternalServerError',
+    'InternalFailure',
+    'InternalServiceError',
+    'ServiceUnavailable',
+}
+
+# Per thread: invocation = {'budget': retries left, 'deadline': monotonic seconds or None}
+_state = threading.local()
+
+
+def _invocation():
+    if not hasattr(_state, 'invocation'):
+        _state.invocation = {'budget': RETRY_BUDGET_PER_INVOCATION, 'deadline': None}
+    return _state.invocation
+
+
+def begin_invocation(context=None):
+    """Resets the retry budget and takes the deadline from the Lambda context (if any)."""
+    deadline = None
+    get_remaining = getattr(context, 'get_remaining_time_in_millis', None)
+    if callable(get_remaining):
+        try:
+            deadline = time.monotonic() + get_remaining() / 1000.0
+        except Exception:
+            logger.warning("Could not read remaining time from the Lambda context")
+    _state.invocation = {'budget': RETRY_BUDGET_PER_INVOCATION, 'deadline': deadline}
+
+
+def per_invocation(func):
+    """Decorator for Lambda handlers(event, context): starts a fresh retry budget per invocation."""
+    @functools.wraps(func)
+    def wrapper(event, context, *args, **kwargs):
+        begin_invocation(context)
+        return func(event, context, *args, **kwargs)
+    return wrapper
+
+
+def remaining_seconds():
+    """Seconds left before the invocation's deadline minus RETRY_DEADLINE_MARGIN_MS, or None if unknown."""
+    deadline = _invocation()['deadline']
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.monotonic() - RETRY_DEADLINE_MARGIN_MS / 1000.0)
+
+
+def max_attempts(operation):
+    if operation in MAX_ATTEMPTS:
+        return MAX_ATTEMPTS[operation]
+    return MAX_ATTEMPTS.get(operation.split('.', 1)[0], DEFAULT_MAX_ATTEMPTS)
+
+
+def is_retryable(error_code, idempotent=True):
+    return error_code in THROTTLING_ERROR_CODES or (idempotent and error_code in SERVER_ERROR_CODES)
+
+
+def _next_delay(previous_seconds):
+    base = RETRY_BASE_DELAY_MS / 1000.0
+    cap = RETRY_MAX_DELAY_MS / 1000.0
+    return min(cap, random.uniform(base, max(base, previous_seconds * 3)))
+
+
+def _reserve_retry(delay_seconds):
+    """Takes one retry from the budget if the deadline allows. Returns None or the reason it was refused."""
+    invocation = _invocation()
+    deadline = invocation['deadline']
+    if deadline is not None and time.monotonic() + delay_seconds + RETRY_DEADLINE_MARGIN_MS / 1000.0 >= deadline:
+        return 'deadline'
+    if invocation['budget'] <= 0:
+        return 'budget'
+    invocation['budget'] -= 1
+    return None
+
+
+def call(operation, fn, *args, idempotent=True, **kwargs):
+    """
+    Calls fn(*args, **kwargs), retrying transient ClientErrors per the policy above.
+    Returns fn's result; re-raises the last error once retries are exhausted or refused.
+    """
+    attempts = max_attempts(operation)
+    attempt = 1
+    delay = RETRY_BASE_DELAY_MS / 1000.0
+    while True:
+        try:
+            return fn(*args, **kwargs)
+        except ClientError as e:
+            error_code = e.response.get('Error', {}).get('Code')
+            if not RETRY_ENABLED or attempt >= attempts or not is_retryable(error_code, idempotent):
+                raise
+            delay = _next_delay(delay)
+            refused = _reserve_retry(delay)
+            if refused:
+                logger.warning(f"Not retrying {operation} after {error_code}: retry {refused} exhausted")
+                metrics.put_metric(f'retry_{refused}_exhausted', 1, metrics.UNIT_COUNT)
+                raise
+            logger.warning(f"Retrying {operation} after {error_code} in {delay * 1000:.0f}ms (attempt {attempt + 1}/{attempts})")
+            metrics.put_metric('retry_attempt', 1, metrics.UNIT_COUNT)
+            time.sleep(delay)
+            attempt += 1
@@ -8,11 +8,12 @@ to extend the visibility timeout of an SQS message.
 import threading
 import time
 import logging
-import boto3
 import os # Added os import for LOG_LEVEL
 from botocore.exceptions import ClientError
 from typing import Optional
 
+from . import aws_clients, retry_policy
+
 # Initialize logger for this module
 logger = logging.getLogger(__name__)
 logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper()) # Use env var
@@ -55,11 +56,11 @@ class SQSHeartbeat:
         self._running = False
         self._lock = threading.Lock() # Protects access to _error and _running
 
-        # Initialize SQS client within the class
+        # Shared SQS client (boto3 clients are thread-safe)
         # The Lambda execution role must have sqs:ChangeMessageVisibility permission
         try:
-            self._sqs_client = boto3.client("sqs")
-            logger.debug("Internal SQS client initialized for heartbeat.")
+            self._sqs_client = aws_clients.client("sqs")
+            logger.debug("Using shared SQS client for heartbeat.")
         except Exception as e:
             logger.exception("Failed to initialize boto3 SQS client for heartbeat.")
             raise RuntimeError("Could not initialize SQS client for heartbeat") from e
@@ -71,7 +72,10 @@ class SQSHeartbeat:
         while not self._stop_event.wait(self.interval_sec): # Wait for interval or stop signal
             try:
                 logger.info(f"Extending visibility timeout by {self.visibility_timeout_sec}s for receipt handle: ...{self.receipt_handle[-10:]}")
-                self._sqs_client.change_message_visibility(
+                # Each beat gets its own retry budget: a throttle must not stop the heartbeat
+                retry_policy.begin_invocation()
+                retry_policy.call(
+                    'sqs.change_message_visibility', self._sqs_client.change_message_visibility,
                     QueueUrl=self.queue_url,
                     ReceiptHandle=self.receipt_handle,
                     VisibilityTimeout=self.visibility_timeout_sec
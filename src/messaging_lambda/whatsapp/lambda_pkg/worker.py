@@ -0,0 +1,404 @@
+# Messaging Worker - WhatsApp
+
+"""
+Long-running SQS consumer for the messaging pipeline - the alternative to the
+Lambda event source mapping for sustained volume, where an instance per record
+sitting in time.sleep() while an OpenAI run completes costs too much. Each
+record is handled by the Lambda's own handler (index.handler), so both modes
+share every line of business logic:
+
+    cd src/messaging_lambda/whatsapp && python -m lambda_pkg.worker
+
+    receive     long-polls WHATSAPP_QUEUE_URL (WaitTimeSeconds=WORKER_WAIT_SECONDS,
+                MaxNumberOfMessages=WORKER_MAX_MESSAGES) while fewer than
+                WORKER_MAX_IN_FLIGHT records are queued or running
+    shards      WORKER_CONCURRENCY threads. A record goes to shard
+                crc32(conversation) % WORKER_CONCURRENCY, so the triggers of one
+                conversation run one at a time, in the order they were received
+    visibility  an SQSHeartbeat keeps a record hidden while it waits for its
+                shard; once it runs, the handler's own heartbeat takes over
+    deletes     records not reported in batchItemFailures are deleted with
+                DeleteMessageBatch - up to 10 per call, flushed at least every
+                WORKER_DELETE_FLUSH_SECONDS
+    shutdown    SIGTERM / SIGINT stop the receive loop. Records already running
+                finish, queued ones are made visible again for another consumer,
+                and pending deletes are flushed
+
+Failed records are left to reappear after their visibility timeout, as with the
+event source mapping. On a FIFO queue, queued records of a message group whose
+earlier record failed are given back unprocessed, so the group stays in order.
+
+Waits go through this module's `time` (sleep / monotonic), and threads are
+started through `spawn`, so the offline harness can run the worker on its
+virtual clock.
+"""
+
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import uuid
+import zlib
+from collections import deque
+
+from botocore.exceptions import ClientError
+
+from . import index
+from .utils import aws_clients, retry_policy
+from .utils.sqs_heartbeat import SQSHeartbeat
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+
+# --- Configuration ---
+WORKER_CONCURRENCY = int(os.environ.get('WORKER_CONCURRENCY', '8'))
+WORKER_WAIT_SECONDS = int(os.environ.get('WORKER_WAIT_SECONDS', '20'))
+WORKER_MAX_MESSAGES = int(os.environ.get('WORKER_MAX_MESSAGES', '10'))
+# Received but unfinished records (queued + running) before the worker stops receiving
+WORKER_MAX_IN_FLIGHT = int(os.environ.get('WORKER_MAX_IN_FLIGHT', str(WORKER_CONCURRENCY * 2)))
+WORKER_DELETE_FLUSH_SECONDS = float(os.environ.get('WORKER_DELETE_FLUSH_SECONDS', '1.0'))
+WORKER_IDLE_SLEEP_SECONDS = float(os.environ.get('WORKER_IDLE_SLEEP_SECONDS', '0.05'))
+# Backoff after a failed ReceiveMessage
+WORKER_RECEIVE_ERROR_SLEEP_SECONDS = float(os.environ.get('WORKER_RECEIVE_ERROR_SLEEP_SECONDS', '1.0'))
+# A worker has no hard deadline; each record gets a Lambda timeout's worth, counted from when it starts
+WORKER_RECORD_TIMEOUT_MS = int(os.environ.get('WORKER_RECORD_TIMEOUT_MS', '900000'))
+
+# SQS limit for the *Batch calls
+SQS_BATCH_LIMIT = 10
+
+
+def shard_key(record):
+    """The conversation a record belongs to: its FIFO message group, else the body's conversation_id."""
+    group_id = record.get('attributes', {}).get('MessageGroupId')
+    if group_id:
+        return group_id
+    try:
+        return json.loads(record.get('body') or '{}').get('conversation_id') or record['messageId']
+    except (ValueError, AttributeError):
+        return record['messageId']
+
+
+def shard_for(record, shard_count):
+    """Stable shard index for a record (the same in every process)."""
+    return zlib.crc32(shard_key(record).encode('utf-8')) % shard_count
+
+
+def to_lambda_record(message):
+    """An SQS ReceiveMessage message in the shape of a Lambda SQS event record."""
+    return {
+        'messageId': message['MessageId'],
+        'receiptHandle': message['ReceiptHandle'],
+        'body': message.get('Body', ''),
+        'attributes': message.get('Attributes', {}),
+        'messageAttributes': message.get('MessageAttributes', {}),
+        'md5OfBody': message.get('MD5OfBody'),
+        'eventSource': 'aws:sqs',
+    }
+
+
+def _start_thread(target, *args):
+    thread = threading.Thread(target=target, args=args, daemon=True)
+    thread.start()
+    return thread
+
+
+class _WorkerContext:
+    """The parts of the Lambda context object the handler reads. One per record, with its own deadline."""
+
+    def __init__(self, timeout_ms=None):
+        self.function_name = 'whatsapp-messaging-worker'
+        self.aws_request_id = str(uuid.uuid4())
+        self.memory_limit_in_mb = None
+        self._deadline = time.monotonic() + (WORKER_RECORD_TIMEOUT_MS if timeout_ms is None else timeout_ms) / 1000
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self._deadline - time.monotonic()) * 1000))
+
+
+class _QueuedRecord:
+    __slots__ = ('record', 'heartbeat', 'received_at')
+
+    def __init__(self, record, heartbeat, received_at):
+        self.record = record
+        self.heartbeat = heartbeat
+        self.received_at = received_at
+
+
+class SQSWorker:
+    """
+    Polls one queue and runs `handler` (index.handler by default) on each record.
+
+        worker = SQSWorker(queue_url)
+        worker.run()        # blocks until stop() - e.g. from a signal handler - and a clean drain
+    """
+
+    def __init__(self, queue_url, handler=None, concurrency=None, wait_seconds=None, max_messages=None,
+                 max_in_flight=None, sqs_client=None, spawn=None):
+        if not queue_url:
+            raise ValueError("queue_url cannot be empty.")
+        self.queue_url = queue_url
+        self.handler = handler or index.handler
+        self.concurrency = max(1, concurrency or WORKER_CONCURRENCY)
+        self.wait_seconds = WORKER_WAIT_SECONDS if wait_seconds is None else wait_seconds
+        self.max_messages = max(1, min(SQS_BATCH_LIMIT, max_messages or WORKER_MAX_MESSAGES))
+        self.max_in_flight = max(1, max_in_flight or WORKER_MAX_IN_FLIGHT)
+        self.sqs = sqs_client or aws_clients.client('sqs')
+        self._spawn = spawn or _start_thread
+        self._heartbeat_interval_sec = int(os.environ.get('SQS_HEARTBEAT_INTERVAL_MS', '300000')) / 1000
+
+        self._lock = threading.Lock()
+        self._shards = [deque() for _ in range(self.concurrency)]
+        self._in_flight = 0
+        self._pending_deletes = []      # receipt handles of finished records
+        self._failed_groups = {}        # FIFO message group -> monotonic time a record of it failed,
+                                        # kept while records received before then are still queued
+        self._stopping = threading.Event()
+        self._deleter_done = threading.Event()
+        self._receiver = None
+        self._shard_threads = []
+        self._deleter = None
+        self.stats = {'received': 0, 'succeeded': 0, 'failed': 0, 'released': 0, 'deleted': 0}
+
+    # --- Lifecycle ---
+
+    def start(self):
+        """Starts the receive loop, the shard threads and the batch deleter."""
+        if self._receiver is not None:
+            return self
+        logger.info(f"Starting worker on {self.queue_url}: {self.concurrency} shards, up to {self.max_in_flight} records in flight")
+        self._shard_threads = [self._spawn(self._shard_loop, i) for i in range(self.concurrency)]
+        self._deleter = self._spawn(self._delete_loop)
+        self._receiver = self._spawn(self._receive_loop)
+        return self
+
+    def stop(self):
+        """Asks the worker to shut down. Safe to call from a signal handler."""
+        self._stopping.set()
+
+    @property
+    def stopping(self):
+        return self._stopping.is_set()
+
+    def wait(self):
+        """Blocks until stop() is called, then drains the worker. Returns the stats."""
+        while not self._stopping.is_set():
+            time.sleep(WORKER_IDLE_SLEEP_SECONDS)
+        self._join([self._receiver] + self._shard_threads)
+        self._release_queued()
+        self._deleter_done.set()
+        self._join([self._deleter])
+        logger.info(f"Worker on {self.queue_url} stopped: {self.stats}")
+        return dict(self.stats)
+
+    def run(self):
+        """start() + wait()."""
+        self.start()
+        return self.wait()
+
+    @staticmethod
+    def _join(threads):
+        # Poll rather than Thread.join(), so a virtual clock keeps moving while we wait
+        while any(thread is not None and thread.is_alive() for thread in threads):
+            time.sleep(WORKER_IDLE_SLEEP_SECONDS)
+
+    # --- Receiving ---
+
+    def _receive_loop(self):
+        while not self._stopping.is_set():
+            with self._lock:
+                capacity = self.max_in_flight - self._in_flight
+            if capacity <= 0:
+                time.sleep(WORKER_IDLE_SLEEP_SECONDS)
+                continue
+            # A fresh retry budget per poll - this thread never goes through the handler
+            retry_policy.begin_invocation()
+            try:
+                response = retry_policy.call(
+                    'sqs.receive_message', self.sqs.receive_message,
+                    QueueUrl=self.queue_url,
+                    MaxNumberOfMessages=min(self.max_messages, capacity),
+                    WaitTimeSeconds=self.wait_seconds,
+                    AttributeNames=['All'],
+                    MessageAttributeNames=['All']
+                )
+            except ClientError as e:
+                logger.error(f"ReceiveMessage failed on {self.queue_url}: {e}")
+                time.sleep(WORKER_RECEIVE_ERROR_SLEEP_SECONDS)
+                continue
+            except Exception as e:
+                logger.exception(f"Unexpected error receiving from {self.queue_url}: {e}")
+                time.sleep(WORKER_RECEIVE_ERROR_SLEEP_SECONDS)
+                continue
+            for message in response.get('Messages', []):
+                self._dispatch(to_lambda_record(message))
+
+    def _dispatch(self, record):
+        """Queues a received record on its shard, keeping it hidden until a shard thread takes it."""
+        if self._stopping.is_set():
+            self._release([record])
+            return
+        heartbeat = None
+        try:
+            heartbeat = SQSHeartbeat(queue_url=self.queue_url, receipt_handle=record['receiptHandle'],
+                                     interval_sec=self._heartbeat_interval_sec)
+            heartbeat.start()
+        except Exception as e:
+            logger.warning(f"Could not start heartbeat for queued record {record['messageId']}: {e}")
+            heartbeat = None
+        with self._lock:
+            self._shards[shard_for(record, self.concurrency)].append(_QueuedRecord(record, heartbeat, time.monotonic()))
+            self._in_flight += 1
+            self.stats['received'] += 1
+
+    # --- Processing ---
+
+    def _shard_loop(self, shard_index):
+        shard = self._shards[shard_index]
+        while not self._stopping.is_set():
+            with self._lock:
+                queued = shard.popleft() if shard else None
+            if queued is None:
+                time.sleep(WORKER_IDLE_SLEEP_SECONDS)
+                continue
+            try:
+                self._process(queued)
+            finally:
+                with self._lock:
+                    self._in_flight -= 1
+
+    def _process(self, queued):
+        record = queued.record
+        message_id = record['messageId']
+        if queued.heartbeat:
+            queued.heartbeat.stop()
+
+        group_id = record.get('attributes', {}).get('MessageGroupId')
+        if group_id:
+            with self._lock:
+                failed_at = self._failed_groups.get(group_id)
+            if failed_at is not None and queued.received_at <= failed_at:
+                logger.warning(f"An earlier record of message group {group_id} failed. Giving back {message_id} unprocessed.")
+                self._release([record])
+                with self._lock:
+                    self._prune_failed_group(group_id, record)
+                return
+
+        try:
+            response = self.handler({'Records': [record]}, _WorkerContext())
+        except Exception as e:
+            logger.exception(f"Handler raised for record {message_id}: {e}")
+            response = {'batchItemFailures': [{'itemIdentifier': message_id}]}
+
+        failures = {f.get('itemIdentifier') for f in (response or {}).get('batchItemFailures', [])}
+        if message_id in failures:
+            with self._lock:
+                self.stats['failed'] += 1
+                if group_id:
+                    self._failed_groups[group_id] = time.monotonic()
+                    self._prune_failed_group(group_id, record)
+            return
+        with self._lock:
+            self.stats['succeeded'] += 1
+            self._pending_deletes.append(record['receiptHandle'])
+
+    def _prune_failed_group(self, group_id, record):
+        """Forgets a failed group once none of its records received before the failure is queued. Holds _lock."""
+        failed_at = self._failed_groups.get(group_id)
+        if failed_at is None:
+            return
+        shard = self._shards[shard_for(record, self.concurrency)]
+        if not any(item.received_at <= failed_at and item.record.get('attributes', {}).get('MessageGroupId') == group_id
+                   for item in shard):
+            del self._failed_groups[group_id]
+
+    # --- Deleting & releasing ---
+
+    def _delete_loop(self):
+        last_flush = time.monotonic()
+        while True:
+            done = self._deleter_done.is_set()
+            with self._lock:
+                pending = len(self._pending_deletes)
+            if done or pending >= SQS_BATCH_LIMIT or (pending and time.monotonic() - last_flush >= WORKER_DELETE_FLUSH_SECONDS):
+                self._flush_deletes()
+                last_flush = time.monotonic()
+            if done:
+                return
+            time.sleep(WORKER_IDLE_SLEEP_SECONDS)
+
+    def _flush_deletes(self):
+        retry_policy.begin_invocation()
+        with self._lock:
+            receipt_handles, self._pending_deletes = self._pending_deletes, []
+        for start in range(0, len(receipt_handles), SQS_BATCH_LIMIT):
+            chunk = receipt_handles[start:start + SQS_BATCH_LIMIT]
+            entries = [{'Id': str(i), 'ReceiptHandle': handle} for i, handle in enumerate(chunk)]
+            try:
+                response = retry_policy.call(
+                    'sqs.delete_message_batch', self.sqs.delete_message_batch, QueueUrl=self.queue_url, Entries=entries
+                )
+            except ClientError as e:
+                # The records reappear after their visibility timeout and are handled again
+                logger.error(f"DeleteMessageBatch failed for {len(entries)} records on {self.queue_url}: {e}")
+                continue
+            for failure in response.get('Failed', []):
+                logger.error(f"Could not delete record {failure.get('Id')} on {self.queue_url}: {failure.get('Code')} - {failure.get('Message')}")
+            with self._lock:
+                self.stats['deleted'] += len(response.get('Successful', []))
+
+    def _release_queued(self):
+        """Makes every record still waiting for a shard visible again."""
+        with self._lock:
+            queued = [item for shard in self._shards for item in shard]
+            for shard in self._shards:
+                shard.clear()
+            self._failed_groups.clear()
+            self._in_flight -= len(queued)
+        for item in queued:
+            if item.heartbeat:
+                item.heartbeat.stop()
+        self._release([item.record for item in queued])
+
+    def _release(self, records):
+        """Sets the visibility timeout of records to 0, so another consumer can take them now."""
+        retry_policy.begin_invocation()
+        for start in range(0, len(records), SQS_BATCH_LIMIT):
+            chunk = records[start:start + SQS_BATCH_LIMIT]
+            entries = [{'Id': str(i), 'ReceiptHandle': r['receiptHandle'], 'VisibilityTimeout': 0} for i, r in enumerate(chunk)]
+            try:
+                retry_policy.call(
+                    'sqs.change_message_visibility_batch', self.sqs.change_message_visibility_batch,
+                    QueueUrl=self.queue_url, Entries=entries
+                )
+            except ClientError as e:
+                logger.warning(f"Could not release {len(entries)} records on {self.queue_url}, they reappear after their visibility timeout: {e}")
+            with self._lock:
+                self.stats['released'] += len(chunk)
+
+
+def install_signal_handlers(worker):
+    """Stops the worker on SIGTERM (ECS / Kubernetes shutdown) and SIGINT."""
+    def _stop(signum, frame):
+        logger.info(f"Received signal {signum}, shutting down worker...")
+        worker.stop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, _stop)
+
+
+def main():
+    logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper())
+    queue_url = os.environ.get('WHATSAPP_QUEUE_URL')
+    if not queue_url:
+        logger.critical("Missing required environment variable: WHATSAPP_QUEUE_URL")
+        return 1
+    worker = SQSWorker(queue_url)
+    install_signal_handlers(worker)
+    worker.run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,232 @@
+# webhook_handler/core/admission_controller.py
+"""
+Load shedding and backpressure for the staging webhook.
+
+Every downstream call the handler makes (GSI lookup, GetItem, stage write,
+trigger lock, SQS send) is recorded here with its latency and whether it came
+back throttled/transient (e.g. ProvisionedThroughputExceededException, SQS
+RequestThrottled). Outcomes are kept in per-second buckets covering the last
+ADMISSION_WINDOW_SECONDS and reduced to a single pressure score:
+
+    error pressure      - throttled share of calls / ADMISSION_SHED_ERROR_RATE
+    latency pressure    - mean downstream latency / ADMISSION_SHED_LATENCY_MS
+    queue pressure      - (opt-in, ADMISSION_SHED_QUEUE_DEPTH > 0) visible backlog
+                          on the channel queue / ADMISSION_SHED_QUEUE_DEPTH, read
+                          at most every QUEUE_DEPTH_REFRESH_SECONDS
+
+Error and latency pressure need ADMISSION_MIN_SAMPLES calls in the window.
+
+    pressure < ADMISSION_DEGRADED_PRESSURE   normal
+    pressure < 1                             degraded - batch window and stage/lock
+                                             TTLs are lengthened, up to
+                                             ADMISSION_MAX_WINDOW_EXTENSION_SECONDS
+    pressure >= 1                            shedding - a growing share of requests
+                                             (up to ADMISSION_MAX_SHED_FRACTION) is
+                                             rejected with OVERLOADED before any
+                                             downstream call
+
+OVERLOADED takes the transient path, so Twilio redelivers the webhook later
+instead of every request running the full sequence only to fail at the end.
+Shedding is never total: the requests still admitted keep probing the
+dependencies, which is how the controller notices recovery. State is per warm
+container.
+"""
+
+import os
+import time
+import random
+import logging
+import threading
+from contextlib import contextmanager
+
+from . import routing
+from ..services import sqs_service
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+
+# --- Configuration ---
+ADMISSION_CONTROL_ENABLED = os.environ.get('ADMISSION_CONTROL_ENABLED', 'true').lower() == 'true'
+ADMISSION_WINDOW_SECONDS = int(os.environ.get('ADMISSION_WINDOW_SECONDS', '30'))
+ADMISSION_MIN_SAMPLES = int(os.environ.get('ADMISSION_MIN_SAMPLES', '20'))
+# Throttled/transient share of downstream calls at which shedding starts
+ADMISSION_SHED_ERROR_RATE = float(os.environ.get('ADMISSION_SHED_ERROR_RATE', '0.2'))
+# Mean downstream call latency at which shedding starts
+ADMISSION_SHED_LATENCY_MS = float(os.environ.get('ADMISSION_SHED_LATENCY_MS', '1000'))
+# Visible channel-queue backlog at which shedding starts (0 = don't read queue depth)
+ADMISSION_SHED_QUEUE_DEPTH = int(os.environ.get('ADMISSION_SHED_QUEUE_DEPTH', '0'))
+QUEUE_DEPTH_REFRESH_SECONDS = int(os.environ.get('QUEUE_DEPTH_REFRESH_SECONDS', '15'))
+ADMISSION_DEGRADED_PRESSURE = float(os.environ.get('ADMISSION_DEGRADED_PRESSURE', '0.5'))
+ADMISSION_MAX_SHED_FRACTION = float(os.environ.get('ADMISSION_MAX_SHED_FRACTION', '0.9'))
+ADMISSION_MAX_WINDOW_EXTENSION_SECONDS = int(os.environ.get('ADMISSION_MAX_WINDOW_EXTENSION_SECONDS', '30'))
+
+STATE_NORMAL = 'normal'
+STATE_DEGRADED = 'degraded'
+STATE_SHEDDING = 'shedding'
+
+_CHANNEL_QUEUES = {
+    'whatsapp': 'WHATSAPP_QUEUE_URL',
+    'sms': 'SMS_QUEUE_URL',
+    'email': 'EMAIL_QUEUE_URL',
+}
+
+# epoch second -> {'calls': int, 'throttled': int, 'latency_ms': float}
+_buckets = {}
+# queue_url -> {'depth': int or None, 'read_at': epoch}
+_queue_depths = {}
+_lock = threading.Lock()
+
+
+def is_throttled_status(status):
+    """Service-layer status codes that mean the dependency is throttling or transiently failing."""
+    return isinstance(status, str) and status.endswith('TRANSIENT_ERROR')
+
+
+class _Call:
+    """Outcome holder for track(); the caller sets `status` from the service result."""
+
+    def __init__(self):
+        self.status = None
+
+
+@contextmanager
+def track(dependency):
+    """
+    Records one downstream call:
+
+        with admission_controller.track('dynamodb') as call:
+            call.status = dynamodb_service.write_to_stage_table(...)
+
+    An exception escaping the block counts as throttled.
+    """
+    call = _Call()
+    start = time.perf_counter()
+    throttled = True
+    try:
+        yield call
+        throttled = is_throttled_status(call.status)
+    finally:
+        record(dependency, throttled, (time.perf_counter() - start) * 1000.0)
+
+
+def record(dependency, throttled, latency_ms):
+    """Adds a downstream call outcome to the current one-second bucket."""
+    if not ADMISSION_CONTROL_ENABLED:
+        return
+    now = int(time.time())
+    with _lock:
+        bucket = _buckets.setdefault(now, {'calls': 0, 'throttled': 0, 'latency_ms': 0.0})
+        bucket['calls'] += 1
+        bucket['throttled'] += 1 if throttled else 0
+        bucket['latency_ms'] += latency_ms
+        _prune(now)
+    if throttled:
+        logger.debug(f"Recorded throttled {dependency} call ({latency_ms:.1f}ms)")
+
+
+def _prune(now):
+    oldest = now - ADMISSION_WINDOW_SECONDS
+    for second in [s for s in _buckets if s <= oldest]:
+        del _buckets[second]
+
+
+def _window_totals(now):
+    with _lock:
+        _prune(now)
+        calls = sum(b['calls'] for b in _buckets.values())
+        throttled = sum(b['throttled'] for b in _buckets.values())
+        latency_ms = sum(b['latency_ms'] for b in _buckets.values())
+    return calls, throttled, latency_ms
+
+
+def _queue_depth(channel_type, now):
+    """Cached visible depth of the channel's queue, or None if unknown/not configured."""
+    queue_url = getattr(routing, _CHANNEL_QUEUES.get(channel_type, ''), None)
+    if not queue_url:
+        return None
+    with _lock:
+        cached = _queue_depths.get(queue_url)
+        if cached and now - cached['read_at'] < QUEUE_DEPTH_REFRESH_SECONDS:
+            return cached['depth']
+    depth = sqs_service.get_queue_depth(queue_url)
+    with _lock:
+        _queue_depths[queue_url] = {'depth': depth, 'read_at': now}
+    return depth
+
+
+def _pressure(channel_type, now):
+    calls, throttled, latency_ms = _window_totals(now)
+    pressure = 0.0
+    if calls >= ADMISSION_MIN_SAMPLES:
+        if ADMISSION_SHED_ERROR_RATE > 0:
+            pressure = max(pressure, (throttled / calls) / ADMISSION_SHED_ERROR_RATE)
+        if ADMISSION_SHED_LATENCY_MS > 0:
+            pressure = max(pressure, (latency_ms / calls) / ADMISSION_SHED_LATENCY_MS)
+    if ADMISSION_SHED_QUEUE_DEPTH > 0 and channel_type:
+        depth = _queue_depth(channel_type, now)
+        if depth is not None:
+            pressure = max(pressure, depth / ADMISSION_SHED_QUEUE_DEPTH)
+    return pressure
+
+
+def _state(pressure):
+    if pressure >= 1.0:
+        return STATE_SHEDDING
+    if pressure >= ADMISSION_DEGRADED_PRESSURE:
+        return STATE_DEGRADED
+    return STATE_NORMAL
+
+
+def _shed_fraction(pressure):
+    # Ramps from nothing at pressure 1 to the cap at pressure 2
+    if pressure < 1.0:
+        return 0.0
+    return min(ADMISSION_MAX_SHED_FRACTION, pressure - 1.0)
+
+
+def _window_extension(pressure):
+    if pressure < ADMISSION_DEGRADED_PRESSURE or ADMISSION_MAX_WINDOW_EXTENSION_SECONDS <= 0:
+        return 0
+    span = max(1.0 - ADMISSION_DEGRADED_PRESSURE, 1e-9)
+    share = min(1.0, (pressure - ADMISSION_DEGRADED_PRESSURE) / span)
+    return int(round(ADMISSION_MAX_WINDOW_EXTENSION_SECONDS * share))
+
+
+def admit(channel_type=None):
+    """
+    Decides whether to process a webhook.
+
+    Returns:
+        dict: {'admitted': True, 'state', 'pressure', 'window_extension_seconds'} to go ahead.
+              {'admitted': False, 'error_code': 'OVERLOADED', 'message', 'state', 'pressure'}
+              if the request is shed.
+    """
+    if not ADMISSION_CONTROL_ENABLED:
+        return {'admitted': True, 'state': STATE_NORMAL, 'pressure': 0.0, 'window_extension_seconds': 0}
+
+    pressure = _pressure(channel_type, time.time())
+    state = _state(pressure)
+    if state == STATE_SHEDDING and random.random() < _shed_fraction(pressure):
+        logger.warning(f"Shedding {channel_type} webhook (pressure={pressure:.2f})")
+        return {
+            'admitted': False,
+            'error_code': 'OVERLOADED',
+            'message': "Downstream dependencies are overloaded",
+            'state': state,
+            'pressure': pressure,
+        }
+    if state != STATE_NORMAL:
+        logger.info(f"Admission controller {state} (pressure={pressure:.2f})")
+    return {
+        'admitted': True,
+        'state': state,
+        'pressure': pressure,
+        'window_extension_seconds': _window_extension(pressure),
+    }
+
+
+def reset_local_state():
+    """Clears recorded outcomes and cached queue depths (tests, or after an incident)."""
+    with _lock:
+        _buckets.clear()
+        _queue_depths.clear()
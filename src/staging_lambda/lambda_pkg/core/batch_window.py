@@ -0,0 +1,157 @@
+# webhook_handler/core/batch_window.py
+"""
+Adaptive batch window (debounce) selection for channel-queue triggers.
+
+The window is the SQS DelaySeconds applied to the single trigger message sent
+for a burst of fragments. Instead of a fixed BATCH_WINDOW_SECONDS for everyone,
+the window is derived from per-conversation statistics kept on the trigger-lock
+item (see dynamodb_service.acquire_trigger_lock):
+
+    gap_sum_ms / gap_count          - inter-fragment gaps observed inside batches
+    batch_count / fragment_count    - how many fragments a batch usually holds
+    split_count                     - fragments that arrived after the window closed
+
+Fast single-message senders get a short window, users who type in bursts get a
+window long enough to cover their usual gap.
+"""
+
+import math
+import os
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+
+# --- Configuration ---
+# Cold-start window, used until a conversation has enough history (the old fixed value)
+BATCH_WINDOW_SECONDS = int(os.environ.get('BATCH_WINDOW_SECONDS', '10'))
+ADAPTIVE_BATCH_WINDOW_ENABLED = os.environ.get('ADAPTIVE_BATCH_WINDOW_ENABLED', 'true').lower() == 'true'
+MIN_BATCH_WINDOW_SECONDS = int(os.environ.get('MIN_BATCH_WINDOW_SECONDS', '2'))
+MAX_BATCH_WINDOW_SECONDS = max(int(os.environ.get('MAX_BATCH_WINDOW_SECONDS', '20')), BATCH_WINDOW_SECONDS)
+# Window used when the first fragment already looks like a complete message
+EARLY_FLUSH_SECONDS = int(os.environ.get('EARLY_FLUSH_SECONDS', '3'))
+# Window = mean in-batch gap * multiplier (+1s for clock/queue jitter)
+GAP_MULTIPLIER = float(os.environ.get('BATCH_GAP_MULTIPLIER', '2.0'))
+# Minimum number of observed batches before learned stats are trusted
+MIN_HISTORY_BATCHES = int(os.environ.get('BATCH_MIN_HISTORY', '3'))
+# Early flush only for conversations that mostly send one fragment per batch
+EARLY_FLUSH_MAX_FRAGMENTS_PER_BATCH = float(os.environ.get('EARLY_FLUSH_MAX_FRAGMENTS_PER_BATCH', '1.3'))
+
+# SQS hard limit for DelaySeconds
+SQS_MAX_DELAY_SECONDS = 900
+
+# Endings that suggest the user has more to say
+_CONTINUATION_ENDINGS = (',', ':', ';', '-', '...', '…', '&', '+')
+_CONTINUATION_WORDS = {'and', 'but', 'or', 'so', 'because', 'also', 'then', 'plus', 'like', 'with'}
+_TERMINAL_PUNCTUATION = re.compile(r'[.!?)\]"\'’”]\s*$')
+# Short standalone replies that are complete on their own
+_COMPLETE_SHORT_REPLIES = {
+    'ok', 'okay', 'k', 'yes', 'yeah', 'yep', 'no', 'nope', 'thanks', 'thank you', 'thx',
+    'cheers', 'great', 'perfect', 'sure', 'done', 'hi', 'hello', 'bye'
+}
+
+
+def looks_complete(body):
+    """
+    Heuristic: does this fragment read like a complete message on its own?
+
+    True for text ending in terminal punctuation (or a known short reply) that does
+    not end with a continuation marker such as a trailing comma or "and".
+    """
+    if not body:
+        return False
+    text = body.strip()
+    if not text:
+        return False
+
+    if text.endswith(_CONTINUATION_ENDINGS):
+        return False
+    last_word = re.sub(r'[^\w]', '', text.split()[-1].lower())
+    if last_word in _CONTINUATION_WORDS:
+        return False
+
+    normalised = re.sub(r'[^\w\s]', '', text.lower()).strip()
+    if normalised in _COMPLETE_SHORT_REPLIES:
+        return True
+
+    return bool(_TERMINAL_PUNCTUATION.search(text))
+
+
+def _as_number(value, default=0):
+    """Converts DynamoDB numbers (Decimal) and missing values to float."""
+    try:
+        return float(value) if value is not None else float(default)
+    except (TypeError, ValueError):
+        return float(default)
+
+
+def summarize_stats(batch_stats):
+    """
+    Reduces the raw counters stored on the trigger-lock item to the values the
+    window policy needs.
+
+    Returns:
+        dict with 'batches', 'mean_gap_seconds' (None without gap samples),
+        'fragments_per_batch' and 'split_rate'.
+    """
+    batch_stats = batch_stats or {}
+    batches = _as_number(batch_stats.get('batch_count'))
+    fragments = _as_number(batch_stats.get('fragment_count'))
+    gap_count = _as_number(batch_stats.get('gap_count'))
+    gap_sum_ms = _as_number(batch_stats.get('gap_sum_ms'))
+    splits = _as_number(batch_stats.get('split_count'))
+
+    return {
+        'batches': int(batches),
+        'mean_gap_seconds': (gap_sum_ms / gap_count / 1000.0) if gap_count > 0 else None,
+        'fragments_per_batch': (fragments / batches) if batches > 0 else None,
+        'split_rate': (splits / batches) if batches > 0 else 0.0
+    }
+
+
+def _clamp(seconds):
+    upper = min(MAX_BATCH_WINDOW_SECONDS, SQS_MAX_DELAY_SECONDS)
+    return int(max(MIN_BATCH_WINDOW_SECONDS, min(upper, seconds)))
+
+
+def choose_delay_seconds(message_body, batch_stats=None):
+    """
+    Picks the DelaySeconds for the trigger of a new batch.
+
+    Args:
+        message_body (str): Body of the fragment that opened the batch.
+        batch_stats (dict): Counters from the trigger-lock item (may be None/empty).
+
+    Returns:
+        int: Delay in seconds, within [MIN_BATCH_WINDOW_SECONDS, MAX_BATCH_WINDOW_SECONDS].
+    """
+    if not ADAPTIVE_BATCH_WINDOW_ENABLED:
+        return BATCH_WINDOW_SECONDS
+
+    stats = summarize_stats(batch_stats)
+    has_history = stats['batches'] >= MIN_HISTORY_BATCHES
+
+    if has_history and stats['mean_gap_seconds'] is not None:
+        window = math.ceil(stats['mean_gap_seconds'] * GAP_MULTIPLIER) + 1
+    elif has_history:
+        # History but never more than one fragment per batch: the user doesn't burst
+        window = MIN_BATCH_WINDOW_SECONDS
+    else:
+        window = BATCH_WINDOW_SECONDS
+
+    # Late fragments mean the window has been too short - widen proportionally
+    if stats['split_rate'] > 0:
+        window = math.ceil(window * (1 + stats['split_rate']))
+
+    if looks_complete(message_body):
+        single_sender = (
+            not has_history
+            or (stats['fragments_per_batch'] or 0) <= EARLY_FLUSH_MAX_FRAGMENTS_PER_BATCH
+        )
+        if single_sender and stats['split_rate'] == 0:
+            window = min(window, EARLY_FLUSH_SECONDS)
+
+    delay = _clamp(window)
+    logger.info(f"Adaptive batch window: {delay}s (stats={stats}, complete={looks_complete(message_body)})")
+    return delay
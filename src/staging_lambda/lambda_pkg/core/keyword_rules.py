@@ -0,0 +1,150 @@
+# webhook_handler/core/keyword_rules.py
+"""
+Keyword fast path: control messages (STOP, HELP, a bare "ok", ...) are answered
+in the staging Lambda without staging a fragment or queueing an AI trigger.
+
+Rules come from the project's `keyword_rules` config (company-data record, or the
+conversation item's copy), evaluated in order - the first match wins:
+
+    [
+        {"keywords": ["STOP", "UNSUBSCRIBE"], "action": "opt_out",
+         "reply": "You have been unsubscribed. Reply START to resubscribe."},
+        {"keywords": ["START"], "action": "opt_in", "reply": "You are subscribed again."},
+        {"keywords": ["HELP"], "action": "reply", "reply": "Reply STOP to unsubscribe."},
+        {"keywords": ["AGENT", "HUMAN"], "action": "handoff"},
+        {"pattern": "^(ok|okay|thanks?|thank you)\\W*$", "action": "drop"}
+    ]
+
+    keywords  - match the whole message, ignoring case, surrounding whitespace and
+                trailing punctuation ("Stop." matches STOP, "stop sending" does not)
+    pattern   - a regular expression searched for in the stripped message (case-
+                insensitive); anchor it to match the whole message
+    action    - reply     answer with `reply` as TwiML
+                opt_out   set comms_consent false on the conversation, then reply
+                opt_in    set comms_consent true on the conversation, then reply
+                handoff   stage the message for the human handoff queue instead of
+                          the AI (optional `reply` is sent back as TwiML)
+                drop      acknowledge with empty TwiML and do nothing else
+    reply     - optional canned text for every action except drop
+    name      - optional label used in logs (defaults to the rule's position)
+
+Rules are compiled once per warm container and recompiled only when a project's
+rule list changes. Invalid rules (bad regex, unknown action, nothing to match) are
+logged and skipped, so a config mistake never blocks messages.
+"""
+
+import os
+import re
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+
+# --- Configuration ---
+KEYWORD_RULES_ENABLED = os.environ.get('KEYWORD_RULES_ENABLED', 'true').lower() == 'true'
+# Longer messages are never control messages - skip matching them
+KEYWORD_RULES_MAX_BODY_LENGTH = int(os.environ.get('KEYWORD_RULES_MAX_BODY_LENGTH', '160'))
+
+ACTION_REPLY = 'reply'
+ACTION_OPT_OUT = 'opt_out'
+ACTION_OPT_IN = 'opt_in'
+ACTION_HANDOFF = 'handoff'
+ACTION_DROP = 'drop'
+ACTIONS = (ACTION_REPLY, ACTION_OPT_OUT, ACTION_OPT_IN, ACTION_HANDOFF, ACTION_DROP)
+
+_NO_MATCH = {'matched': False}
+_TRAILING_PUNCTUATION = '.!?,;:'
+_WHITESPACE = re.compile(r'\s+')
+
+# (company_id, project_id) -> {'source': rule list as configured, 'rules': compiled rules}
+_compiled = {}
+_lock = threading.Lock()
+
+
+def _normalize(text):
+    """Message or keyword -> the form keywords are compared in."""
+    return _WHITESPACE.sub(' ', str(text)).strip().rstrip(_TRAILING_PUNCTUATION).strip().casefold()
+
+
+def compile_rules(rules):
+    """
+    Compiles a `keyword_rules` list.
+
+    Returns:
+        list: [{'name', 'action', 'reply', 'keywords': frozenset, 'pattern': compiled regex or None}]
+    """
+    compiled = []
+    for position, rule in enumerate(rules or []):
+        if not isinstance(rule, dict):
+            logger.error(f"Skipping keyword rule {position}: not a mapping")
+            continue
+        name = str(rule.get('name') or position)
+        action = str(rule.get('action') or '').lower()
+        if action not in ACTIONS:
+            logger.error(f"Skipping keyword rule '{name}': unknown action '{rule.get('action')}'")
+            continue
+        keywords = frozenset(_normalize(keyword) for keyword in (rule.get('keywords') or []) if _normalize(keyword))
+        pattern = None
+        if rule.get('pattern'):
+            try:
+                pattern = re.compile(rule['pattern'], re.IGNORECASE)
+            except re.error as e:
+                logger.error(f"Skipping keyword rule '{name}': invalid pattern {rule['pattern']!r} ({e})")
+                continue
+        if not keywords and pattern is None:
+            logger.error(f"Skipping keyword rule '{name}': no keywords or pattern")
+            continue
+        reply = rule.get('reply') if action != ACTION_DROP else None
+        compiled.append({'name': name, 'action': action, 'reply': reply or None,
+                         'keywords': keywords, 'pattern': pattern})
+    return compiled
+
+
+def _rules_for(context_object):
+    """The project's compiled rules, compiling them on first use or after a config change."""
+    source = context_object.get('keyword_rules')
+    if not source:
+        return ()
+    key = (context_object.get('company_id'), context_object.get('project_id'))
+    with _lock:
+        entry = _compiled.get(key)
+        if entry is not None and entry['source'] == source:
+            return entry['rules']
+    rules = compile_rules(source)
+    logger.info(f"Compiled {len(rules)} keyword rules for {key[0]}/{key[1]}")
+    with _lock:
+        _compiled[key] = {'source': source, 'rules': rules}
+    return rules
+
+
+def match(context_object):
+    """
+    Checks the inbound message body against the project's keyword rules.
+
+    Returns:
+        dict: {'matched': False} if no rule applies (the message goes on to the AI).
+              {'matched': True, 'rule': name, 'action': ..., 'reply': text or None} otherwise.
+    """
+    if not KEYWORD_RULES_ENABLED:
+        return _NO_MATCH
+    body = context_object.get('body')
+    if not body or len(body) > KEYWORD_RULES_MAX_BODY_LENGTH:
+        return _NO_MATCH
+    rules = _rules_for(context_object)
+    if not rules:
+        return _NO_MATCH
+
+    normalized = _normalize(body)
+    stripped = body.strip()
+    for rule in rules:
+        if normalized in rule['keywords'] or (rule['pattern'] is not None and rule['pattern'].search(stripped)):
+            logger.info(f"Message matched keyword rule '{rule['name']}' (action: {rule['action']})")
+            return {'matched': True, 'rule': rule['name'], 'action': rule['action'], 'reply': rule['reply']}
+    return _NO_MATCH
+
+
+def reset_local_state():
+    """Drops the compiled rules (tests, or after a config change)."""
+    with _lock:
+        _compiled.clear()
@@ -0,0 +1,173 @@
+# webhook_handler/core/rate_limiter.py
+"""
+Per-company inbound rate limiting.
+
+Limits come from the company's `rate_limits` config (copied onto the conversation
+record), falling back to the DEFAULT_* environment variables; 0 means unlimited:
+
+    requests_per_minute   - inbound messages per company per calendar minute
+    requests_per_day      - inbound messages per company per UTC day
+
+The shared counts are DynamoDB atomic counters with time-bucketed keys
+(dynamodb_service.reserve_rate_limit_tokens). To avoid a round trip per message,
+each container reserves a small lease of tokens at a time and spends it from a
+local token bucket. Each window has its own lease and bucket, so a message
+leases on a counter only when that window's local tokens are used up. Leases
+are sized at a fraction of the limit, so unused tokens in idle containers can
+only cost a few requests of headroom.
+
+Counter failures fail open: a DynamoDB problem must not stop replies.
+"""
+
+import os
+import time
+import logging
+import threading
+
+from ..services import dynamodb_service
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+
+# --- Configuration ---
+RATE_LIMITING_ENABLED = os.environ.get('RATE_LIMITING_ENABLED', 'true').lower() == 'true'
+DEFAULT_REQUESTS_PER_MINUTE = int(os.environ.get('DEFAULT_REQUESTS_PER_MINUTE', '0'))
+DEFAULT_REQUESTS_PER_DAY = int(os.environ.get('DEFAULT_REQUESTS_PER_DAY', '0'))
+# Most tokens a container reserves per DynamoDB round trip
+RATE_LIMIT_LEASE_SIZE = int(os.environ.get('RATE_LIMIT_LEASE_SIZE', '10'))
+# A lease never exceeds limit / divisor, so several warm containers can share the limit
+RATE_LIMIT_LEASE_DIVISOR = int(os.environ.get('RATE_LIMIT_LEASE_DIVISOR', '20'))
+# Counter items outlive their bucket by this much before TTL removes them
+COUNTER_TTL_BUFFER_SECONDS = int(os.environ.get('RATE_LIMIT_COUNTER_TTL_BUFFER_SECONDS', '300'))
+
+WINDOWS = (
+    # (limit field, key tag, bucket length in seconds)
+    ('requests_per_minute', 'm', 60),
+    ('requests_per_day', 'd', 86400),
+)
+
+# company_id -> {'buckets': {tag: bucket_no}, 'tokens': {tag: int}, 'blocked_until': epoch}
+_local_buckets = {}
+_lock = threading.Lock()
+
+
+def _limit(value, default):
+    try:
+        return max(int(value), 0) if value is not None else default
+    except (TypeError, ValueError):
+        return default
+
+
+def resolve_limits(context_object):
+    """Returns {'requests_per_minute': int, 'requests_per_day': int} for the conversation's company."""
+    rate_limits = context_object.get('rate_limits') or {}
+    return {
+        'requests_per_minute': _limit(rate_limits.get('requests_per_minute'), DEFAULT_REQUESTS_PER_MINUTE),
+        'requests_per_day': _limit(rate_limits.get('requests_per_day'), DEFAULT_REQUESTS_PER_DAY),
+    }
+
+
+def _lease_size(limit):
+    return max(1, min(RATE_LIMIT_LEASE_SIZE, limit // RATE_LIMIT_LEASE_DIVISOR))
+
+
+def _reserve_window(company_id, limit, tag, bucket, length):
+    """
+    Leases tokens on one window's counter, falling back to a single token when
+    the lease no longer fits. Returns (status, amount): 'RESERVED', 'LIMIT_EXCEEDED' or 'ERROR'.
+    """
+    bucket_end = (bucket + 1) * length
+    counter_key = f"ratelimit#{company_id}#{tag}#{bucket}"
+    for amount in sorted({_lease_size(limit), 1}, reverse=True):
+        result = dynamodb_service.reserve_rate_limit_tokens(
+            counter_key, amount, limit, bucket_end + COUNTER_TTL_BUFFER_SECONDS
+        )
+        status = result.get('status')
+        if status == 'RESERVED':
+            return 'RESERVED', amount
+        if status != 'LIMIT_EXCEEDED':
+            logger.warning(f"Rate limit counter unavailable for company {company_id} ({status}); allowing request")
+            return 'ERROR', 0
+    return 'LIMIT_EXCEEDED', 0
+
+
+def check_rate_limit(context_object):
+    """
+    Consumes one inbound request from the company's rate limits.
+
+    Every window keeps its own local tokens: a minute rollover drops only the
+    minute tokens, so day tokens leased earlier are still spent that day.
+
+    Returns:
+        dict: {'valid': True} if the request may proceed.
+              {'valid': False, 'error_code': 'RATE_LIMITED', 'message': ...} if over a limit.
+    """
+    company_id = context_object.get('company_id')
+    if not RATE_LIMITING_ENABLED or not company_id:
+        return {'valid': True}
+
+    limits = resolve_limits(context_object)
+    windows = [(field, tag, length) for field, tag, length in WINDOWS if limits[field]]
+    if not windows:
+        return {'valid': True}
+
+    now = time.time()
+    buckets = {tag: int(now // length) for _, tag, length in windows}
+
+    with _lock:
+        state = _local_buckets.setdefault(company_id, {'buckets': {}, 'tokens': {}, 'blocked_until': 0})
+        for tag, bucket in buckets.items():
+            if state['buckets'].get(tag) != bucket:
+                # A new bucket - leftover tokens belonged to the old one's counter
+                state['buckets'][tag] = bucket
+                state['tokens'][tag] = 0
+        if state['blocked_until'] > now:
+            return _rejected(company_id)
+        empty = [window for window in windows if state['tokens'][window[1]] <= 0]
+        if not empty:
+            for tag in buckets:
+                state['tokens'][tag] -= 1
+            return {'valid': True}
+
+    # Some local windows are empty - lease more tokens from their shared counters
+    leased = []
+    for field, tag, length in empty:
+        status, amount = _reserve_window(company_id, limits[field], tag, buckets[tag], length)
+        if status == 'ERROR':
+            with _lock:
+                _add_tokens(state, buckets, leased)
+            return {'valid': True}
+        if status == 'LIMIT_EXCEEDED':
+            # Give back what this request already leased on the other windows
+            for leased_tag, leased_amount in leased:
+                dynamodb_service.release_rate_limit_tokens(
+                    f"ratelimit#{company_id}#{leased_tag}#{buckets[leased_tag]}", leased_amount
+                )
+            with _lock:
+                state['blocked_until'] = (buckets[tag] + 1) * length
+            return _rejected(company_id)
+        leased.append((tag, amount))
+
+    with _lock:
+        _add_tokens(state, buckets, leased)
+        for tag in buckets:
+            state['tokens'][tag] -= 1
+    return {'valid': True}
+
+
+def _add_tokens(state, buckets, leased):
+    """Adds leased tokens to the local buckets (caller holds _lock), skipping buckets that rolled over meanwhile."""
+    for tag, amount in leased:
+        if state['buckets'].get(tag) == buckets[tag]:
+            state['tokens'][tag] += amount
+
+
+def _rejected(company_id):
+    logger.warning(f"Rate limit exceeded for company {company_id}")
+    return {'valid': False, 'error_code': 'RATE_LIMITED', 'message': f"Rate limit exceeded for company {company_id}"}
+
+
+def reset_local_state():
+    """Clears the per-container token buckets (tests, or after a config change)."""
+    with _lock:
+        _local_buckets.clear()
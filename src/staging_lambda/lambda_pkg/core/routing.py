@@ -55,7 +55,7 @@ def determine_target_queue(context_object):
         return HANDOFF_QUEUE_URL
     
     # 3. Check channel-specific auto_queue list
-    # Assumes context_object was updated by check_conversation_exists 
+    # Assumes context_object was updated from the conversation record (get_full_conversation)
     # and contains recipient_tel/recipient_email from the DB record.
     if channel_type in ['whatsapp', 'sms']:
         # Ensure the list exists and handle None case gracefully
@@ -0,0 +1,123 @@
+# webhook_handler/core/sender_filter.py
+"""
+Cheap in-process rejection of webhooks that cannot match a conversation.
+
+Two checks run before the GSI credential lookup:
+
+    negative cache      - (channel, To, From) pairs whose lookup returned NOT_FOUND
+                          are remembered for NEGATIVE_CACHE_TTL_SECONDS in a bounded
+                          LRU (NEGATIVE_CACHE_MAX_ENTRIES), so a repeat unknown sender
+                          is rejected without another query.
+    known company numbers (opt-in, KNOWN_NUMBER_FILTER_ENABLED) - the company numbers
+                          configured in the company-data table, loaded on first use and
+                          refreshed every KNOWN_NUMBERS_REFRESH_SECONDS. Webhooks to any
+                          other `To` number are rejected without a query. Only enable
+                          this once every live conversation's company number is in the
+                          company-data table.
+
+The TTL is short because a conversation created for a sender after a miss stays
+invisible to that sender until the entry expires. Both checks fail open: if the
+company numbers cannot be loaded, every `To` number is allowed.
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from ..services import company_config_service
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+
+# --- Configuration ---
+NEGATIVE_CACHE_ENABLED = os.environ.get('NEGATIVE_CACHE_ENABLED', 'true').lower() == 'true'
+NEGATIVE_CACHE_TTL_SECONDS = int(os.environ.get('NEGATIVE_CACHE_TTL_SECONDS', '60'))
+NEGATIVE_CACHE_MAX_ENTRIES = int(os.environ.get('NEGATIVE_CACHE_MAX_ENTRIES', '10000'))
+KNOWN_NUMBER_FILTER_ENABLED = os.environ.get('KNOWN_NUMBER_FILTER_ENABLED', 'false').lower() == 'true'
+KNOWN_NUMBERS_REFRESH_SECONDS = int(os.environ.get('KNOWN_NUMBERS_REFRESH_SECONDS', '300'))
+
+# (channel, to, from) -> expires_at, oldest first
+_negative_cache = OrderedDict()
+# {'numbers': {channel: set()} or None, 'loaded_at': epoch}
+_known_numbers = {'numbers': None, 'loaded_at': None}
+_lock = threading.Lock()
+
+
+def _strip_prefix(channel_type, value):
+    prefix = f"{channel_type}:"
+    if value and value.startswith(prefix):
+        return value[len(prefix):]
+    return value
+
+
+def _key(channel_type, from_id, to_id):
+    return (channel_type, _strip_prefix(channel_type, to_id), _strip_prefix(channel_type, from_id))
+
+
+def _known_company_numbers(channel_type, now):
+    """Returns the set of known company identifiers for a channel, or None if unavailable."""
+    with _lock:
+        loaded_at = _known_numbers['loaded_at']
+        if loaded_at is not None and now - loaded_at < KNOWN_NUMBERS_REFRESH_SECONDS:
+            numbers = _known_numbers['numbers']
+            return numbers.get(channel_type) if numbers is not None else None
+
+    numbers = company_config_service.load_company_identifiers()
+    with _lock:
+        # Keep the previous set if a refresh fails
+        if numbers is not None or _known_numbers['loaded_at'] is None:
+            _known_numbers['numbers'] = numbers
+        _known_numbers['loaded_at'] = now
+        current = _known_numbers['numbers']
+    return current.get(channel_type) if current is not None else None
+
+
+def check_sender(channel_type, from_id, to_id):
+    """
+    Returns:
+        dict: {'valid': True} if the webhook should go on to the GSI lookup.
+              {'valid': False, 'error_code': 'NOT_FOUND', 'message': ...} if it can be rejected here.
+    """
+    now = time.time()
+
+    if NEGATIVE_CACHE_ENABLED:
+        key = _key(channel_type, from_id, to_id)
+        with _lock:
+            expires_at = _negative_cache.get(key)
+            if expires_at is not None:
+                if expires_at > now:
+                    _negative_cache.move_to_end(key)
+                    logger.info(f"Rejecting {channel_type} sender {key[2]} -> {key[1]} from the negative cache")
+                    return {'valid': False, 'error_code': 'NOT_FOUND', 'message': "No conversation for sender (cached)"}
+                del _negative_cache[key]
+
+    if KNOWN_NUMBER_FILTER_ENABLED:
+        known = _known_company_numbers(channel_type, now)
+        to_value = _strip_prefix(channel_type, to_id)
+        if known is not None and to_value not in known:
+            logger.info(f"Rejecting {channel_type} webhook to unknown company identifier {to_value}")
+            return {'valid': False, 'error_code': 'NOT_FOUND', 'message': "Unknown company identifier"}
+
+    return {'valid': True}
+
+
+def record_not_found(channel_type, from_id, to_id):
+    """Remembers a (channel, To, From) whose credential lookup found no conversation."""
+    if not NEGATIVE_CACHE_ENABLED or NEGATIVE_CACHE_MAX_ENTRIES <= 0:
+        return
+    key = _key(channel_type, from_id, to_id)
+    with _lock:
+        _negative_cache[key] = time.time() + NEGATIVE_CACHE_TTL_SECONDS
+        _negative_cache.move_to_end(key)
+        while len(_negative_cache) > NEGATIVE_CACHE_MAX_ENTRIES:
+            _negative_cache.popitem(last=False)
+
+
+def reset_local_state():
+    """Clears the negative cache and known company numbers (tests, or after a config change)."""
+    with _lock:
+        _negative_cache.clear()
+        _known_numbers['numbers'] = None
+        _known_numbers['loaded_at'] = None
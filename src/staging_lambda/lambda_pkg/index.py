@@ -3,6 +3,7 @@
 import json
 import logging # Import logging
 import os # Added os import
+from xml.sax.saxutils import escape as xml_escape
 # Removed urllib.parse import as it's now in parsing_utils
 
 # Placeholder for future modular functions
@@ -13,10 +14,18 @@ import os # Added os import
 from .utils import parsing_utils # Import the module
 from .core import validation
 from .core import routing # Import the new routing module
+from .core import batch_window
+from .core import rate_limiter
+from .core import sender_filter
+from .core import admission_controller
+from .core import keyword_rules
 from .services import dynamodb_service
 from .services import sqs_service
 from .services import secrets_manager_service # Import new service
+from .services import company_config_service
 from .utils import response_builder
+from .utils import metrics
+from .utils import retry_policy
 
 # Twilio Validation Import
 from twilio.request_validator import RequestValidator
@@ -35,7 +44,23 @@ TRANSIENT_ERROR_CODES = {
     'STAGE_DB_TRANSIENT_ERROR',
     'TRIGGER_DB_TRANSIENT_ERROR',
     'SQS_TRANSIENT_ERROR',
-    'SECRET_FETCH_TRANSIENT_ERROR' # Assuming secrets manager might have transient issues
+    'PAYLOAD_STORE_TRANSIENT_ERROR', # Handoff payload claim-check write (utils/payload_codec.py)
+    'SECRET_FETCH_TRANSIENT_ERROR', # Assuming secrets manager might have transient issues
+    'OVERLOADED' # Shed by the admission controller - Twilio should redeliver later
+}
+
+# User-facing TwiML for limit rejections (empty string = reply with empty TwiML)
+RATE_LIMITED_TWIML_MESSAGE = os.environ.get(
+    'RATE_LIMITED_TWIML_MESSAGE',
+    "You're sending messages faster than we can handle. Please wait a moment and try again."
+)
+MESSAGE_TOO_LONG_TWIML_MESSAGE = os.environ.get(
+    'MESSAGE_TOO_LONG_TWIML_MESSAGE',
+    "Your message is too long. Please send a shorter message."
+)
+LIMIT_TWIML_MESSAGES = {
+    'RATE_LIMITED': RATE_LIMITED_TWIML_MESSAGE,
+    'MESSAGE_TOO_LONG': MESSAGE_TOO_LONG_TWIML_MESSAGE,
 }
 
 # Removed placeholder Queue constants - they now live in routing.py
@@ -69,6 +94,11 @@ def _determine_final_error_response(context_object_or_channel_type, error_code,
                 return response_builder.create_twiml_error_response(
                     "I'm processing your previous message. Please wait for my response before sending more."
                 )
+            elif error_code in LIMIT_TWIML_MESSAGES:
+                message = LIMIT_TWIML_MESSAGES[error_code]
+                if message:
+                    return response_builder.create_twiml_error_response(xml_escape(message))
+                return response_builder.create_success_response_twiml()
             elif error_code == 'INVALID_SIGNATURE':
                  # Security: Log critical, return generic empty TwiML to prevent info leak
                  logger.critical("Invalid Twilio Signature - returning empty TwiML")
@@ -83,6 +113,43 @@ def _determine_final_error_response(context_object_or_channel_type, error_code,
 
 # Removed _determine_target_queue - it now lives in core/routing.py
 
+def _keyword_reply_response(channel_type, reply, action):
+    """Success response for a message answered by a keyword rule (canned reply or empty TwiML)."""
+    if channel_type in ['whatsapp', 'sms']:
+        if reply:
+            return response_builder.create_twiml_error_response(xml_escape(reply))
+        return response_builder.create_success_response_twiml()
+    return response_builder.create_success_response_json(data={'keyword_action': action}, message=reply or "Message received")
+
+def _record_keyword_consent(context_object, primary_channel_key, keyword_match):
+    """Records the consent change of an opt_out / opt_in rule. Returns an error response on failure, else None."""
+    action = keyword_match['action']
+    if action not in (keyword_rules.ACTION_OPT_OUT, keyword_rules.ACTION_OPT_IN):
+        return None
+    conversation_id = context_object.get('conversation_id')
+    with metrics.timer('consent_update'), admission_controller.track('dynamodb') as call:
+        consent_status = dynamodb_service.set_comms_consent(
+            primary_channel_key, conversation_id, action == keyword_rules.ACTION_OPT_IN,
+            f"keyword:{keyword_match['rule']}"
+        )
+        call.status = consent_status
+    if consent_status != 'SUCCESS':
+        logger.error(f"Failed to record {action} for conversation {conversation_id}. Status: {consent_status}")
+        return _determine_final_error_response(context_object, consent_status, f"Failed to record {action}")
+    return None
+
+def _apply_keyword_rule(context_object, primary_channel_key, keyword_match):
+    """Carries out a matched reply / opt_out / opt_in / drop rule and returns the webhook response."""
+    action = keyword_match['action']
+    conversation_id = context_object.get('conversation_id')
+    error_response = _record_keyword_consent(context_object, primary_channel_key, keyword_match)
+    if error_response:
+        return error_response
+    logger.info(f"Keyword rule '{keyword_match['rule']}' handled message for {conversation_id} ({action}); no AI trigger queued.")
+    return _keyword_reply_response(context_object.get('channel_type'), keyword_match.get('reply'), action)
+
+@metrics.flush_after_invocation
+@retry_policy.per_invocation
 def handler(event, context):
     """Main Lambda handler function with Late Validation flow."""
     logger.info(f"Received event: {json.dumps(event)}")
@@ -94,7 +161,8 @@ def handler(event, context):
 
     try:
         # --- Step 1: Parsing (Enhanced) ---
-        parsing_result = parsing_utils.parse_incoming_request(event)
+        with metrics.timer('parse'):
+            parsing_result = parsing_utils.parse_incoming_request(event)
         if not parsing_result or not parsing_result.get('success'):
             logger.error("Failed during initial request parsing.")
             path = event.get('path', '')
@@ -113,6 +181,7 @@ def handler(event, context):
         conversation_id = context_object.get('conversation_id') # Derived in parser
         # Store the incoming message SID before overwriting context
         incoming_message_sid = context_object.get('message_sid') or context_object.get('email_id')
+        metrics.set_dimensions(channel=channel_type)
 
         logger.info(f"Processing initial request for conversation {conversation_id} (Channel: {channel_type}, SID: {incoming_message_sid})")
 
@@ -121,10 +190,28 @@ def handler(event, context):
              return _determine_final_error_response(channel_type or 'unknown', 'PARSING_ERROR', "Missing essential identifiers.")
 
         # --- Step 2: Get Credential Reference --- (Minimal DB Query)
+        # Repeat unknown senders / unknown company numbers are rejected without a query
+        sender_check = sender_filter.check_sender(channel_type, from_id, to_id)
+        if not sender_check['valid']:
+            metrics.put_metric('sender_rejected_cached', 1, metrics.UNIT_COUNT)
+            return _determine_final_error_response(channel_type, sender_check['error_code'], sender_check.get('message'))
+
+        # Shed load before any downstream call while DynamoDB/SQS are throttling
+        admission = admission_controller.admit(channel_type)
+        metrics.put_metric('admission_pressure', round(admission['pressure'], 3), metrics.UNIT_NONE)
+        if not admission['admitted']:
+            metrics.put_metric('admission_shed', 1, metrics.UNIT_COUNT)
+            return _determine_final_error_response(channel_type, admission['error_code'], admission.get('message'))
+        window_extension_seconds = admission['window_extension_seconds']
+
         logger.debug(f"Looking up credential reference for {channel_type} from {from_id} to {to_id}")
-        credential_lookup = dynamodb_service.get_credential_ref_for_validation(channel_type, from_id, to_id)
+        with metrics.timer('gsi_lookup'), admission_controller.track('dynamodb') as call:
+            credential_lookup = dynamodb_service.get_credential_ref_for_validation(channel_type, from_id, to_id)
+            call.status = credential_lookup.get('status')
 
         lookup_status = credential_lookup.get('status')
+        if lookup_status == 'NOT_FOUND':
+            sender_filter.record_not_found(channel_type, from_id, to_id)
         if lookup_status != 'FOUND':
             error_message = f"Credential lookup failed with status: {lookup_status}"
             # Map specific DB failures to appropriate response handling
@@ -136,7 +223,8 @@ def handler(event, context):
         logger.info(f"Found credential reference for conversation {conversation_id}: {credential_ref}")
 
         # --- Step 3: Fetch Specific Auth Token --- (Secrets Manager Call)
-        retrieved_auth_token = secrets_manager_service.get_twilio_auth_token(credential_ref)
+        with metrics.timer('secret_fetch'):
+            retrieved_auth_token = secrets_manager_service.get_twilio_auth_token(credential_ref)
         if not retrieved_auth_token:
             logger.error(f"Failed to retrieve secret '{credential_ref}' from Secrets Manager for conversation {conversation_id}.")
             # Assume non-transient for now unless secrets service returns specific transient error
@@ -158,11 +246,12 @@ def handler(event, context):
              logger.error(f"Missing URL or parsed body; cannot validate request for conversation {conversation_id}.")
              return _determine_final_error_response(channel_type, 'INTERNAL_ERROR', 'Parsing failed to provide validation components')
 
-        is_valid = validator.validate(
-            request_url,
-            parsed_body_params,
-            signature_header
-        )
+        with metrics.timer('signature_validation'):
+            is_valid = validator.validate(
+                request_url,
+                parsed_body_params,
+                signature_header
+            )
 
         if not is_valid:
             # Logged as CRITICAL in _determine_final_error_response if needed
@@ -189,9 +278,23 @@ def handler(event, context):
              logger.error(f"Cannot determine primary channel key (from_id) for GetItem for {conversation_id}")
              return _determine_final_error_response(channel_type, 'INTERNAL_ERROR', "Cannot determine primary key for context lookup")
 
+        # Company config comes from the cached company-data record when there is one;
+        # the conversation item then only needs its per-conversation fields
+        with metrics.timer('company_config'):
+            _, company_config = company_config_service.get_company_config(
+                credential_lookup.get('company_id'), credential_lookup.get('project_id')
+            )
+
         # conversation_id came definitively from the GSI lookup
         logger.info(f"Fetching full context for validated conversation PK={primary_channel_key}, SK={conversation_id}")
-        context_lookup = dynamodb_service.get_full_conversation(primary_channel_key, conversation_id)
+        with metrics.timer('get_item'), admission_controller.track('dynamodb') as call:
+            if company_config:
+                context_lookup = dynamodb_service.get_full_conversation(
+                    primary_channel_key, conversation_id, attributes=dynamodb_service.CONVERSATION_FIELDS
+                )
+            else:
+                context_lookup = dynamodb_service.get_full_conversation(primary_channel_key, conversation_id)
+            call.status = context_lookup.get('status')
         context_status = context_lookup.get('status')
 
         if context_status != 'FOUND':
@@ -201,6 +304,9 @@ def handler(event, context):
         # --- MERGE data from DB into existing context_object --- #
         db_data = context_lookup.get('data', {})
         context_object.update(db_data) # Merge DB data into the context from initial parse
+        if company_config:
+            context_object.update(company_config_service.channel_view(company_config, db_data.get('channel_method') or channel_type))
+        metrics.set_dimensions(company_id=db_data.get('company_id'))
         logger.debug(f"Successfully merged DB data into context object for {conversation_id}")
 
         # --- Step 6+: Existing Logic (Now uses the merged context object) ---
@@ -209,32 +315,91 @@ def handler(event, context):
         # --- Rule Validation (Uses channel_type from initial parse, other fields from DB merge) ---
         rules_check = validation.validate_conversation_rules(context_object)
         if not rules_check['valid']:
+            if rules_check.get('error_code') == 'CONVERSATION_LOCKED':
+                # Fragment missed its batch window - feed that back into the adaptive window
+                dynamodb_service.record_late_fragment(conversation_id)
             return _determine_final_error_response(context_object, rules_check.get('error_code', 'VALIDATION_FAILED'), rules_check.get('message'))
 
+        # --- Per-company Rate Limits (ahead of the keyword fast path, so canned replies count too) ---
+        keyword_match = keyword_rules.match(context_object)
+        with metrics.timer('rate_limit'):
+            rate_check = rate_limiter.check_rate_limit(context_object)
+        if not rate_check['valid']:
+            metrics.put_metric('rate_limited', 1, metrics.UNIT_COUNT)
+            if keyword_match['matched']:
+                # An opt-out / opt-in is still recorded - only its canned reply is withheld
+                error_response = _record_keyword_consent(context_object, primary_channel_key, keyword_match)
+                if error_response:
+                    return error_response
+            return _determine_final_error_response(context_object, rate_check['error_code'], rate_check.get('message'))
+
+        # --- Keyword Fast Path (opt-outs and control messages skip the AI) ---
+        keyword_reply = None
+        if keyword_match['matched']:
+            metrics.put_metric(f"keyword_{keyword_match['action']}", 1, metrics.UNIT_COUNT)
+            if keyword_match['action'] != keyword_rules.ACTION_HANDOFF:
+                return _apply_keyword_rule(context_object, primary_channel_key, keyword_match)
+            # Handoff: staged and queued as usual, but for a human instead of the AI
+            context_object['keyword_rule'] = keyword_match['rule']
+            keyword_reply = keyword_match.get('reply')
+
         # --- Routing ---
-        target_queue_url = routing.determine_target_queue(context_object)
+        if keyword_match['matched']:
+            target_queue_url = routing.HANDOFF_QUEUE_URL
+        else:
+            target_queue_url = routing.determine_target_queue(context_object)
         if not target_queue_url:
             logger.error(f"Failed to determine target queue URL for conversation: {conversation_id}")
             return _determine_final_error_response(context_object, 'ROUTING_ERROR', "Could not determine routing queue")
 
         # --- Staging ---
         logger.info(f"Attempting to write to stage table for conversation: {conversation_id}")
-        stage_write_status = dynamodb_service.write_to_stage_table(context_object)
+        with metrics.timer('stage_write'), admission_controller.track('dynamodb') as call:
+            stage_write_status = dynamodb_service.write_to_stage_table(
+                context_object, window_extension_seconds=window_extension_seconds
+            )
+            call.status = stage_write_status
         if stage_write_status != 'SUCCESS':
             logger.error(f"Failed to write message to stage table for conversation: {conversation_id}. Status: {stage_write_status}")
             return _determine_final_error_response(context_object, stage_write_status, "Failed to stage message details")
 
         # --- Locking & Queuing ---
         should_send_sqs_message = False
+        trigger_delay_seconds = None
+        fifo_extension_seconds = 0
         if target_queue_url == routing.HANDOFF_QUEUE_URL:
             logger.info(f"Routing message directly to handoff queue for conversation: {conversation_id}")
             should_send_sqs_message = True
+        elif sqs_service.is_fifo_queue(target_queue_url):
+            # FIFO channel queue: SQS deduplicates the triggers of one batch window,
+            # so there is no trigger lock to take. No lock item means no learned stats either.
+            logger.info(f"FIFO channel queue for {conversation_id}, sending deduplicated trigger without trigger lock.")
+            should_send_sqs_message = True
+            trigger_delay_seconds = batch_window.BATCH_WINDOW_SECONDS
+            if window_extension_seconds:
+                # Extends the trigger's deadline only - the deduplication window stays the same
+                fifo_extension_seconds = window_extension_seconds
+                metrics.put_metric('batch_window_extension', window_extension_seconds, metrics.UNIT_SECONDS)
         else:
             logger.info(f"Attempting to acquire trigger lock for conversation: {conversation_id}")
-            lock_status = dynamodb_service.acquire_trigger_lock(conversation_id)
+            with metrics.timer('trigger_lock'), admission_controller.track('dynamodb') as call:
+                lock_result = dynamodb_service.acquire_trigger_lock(
+                    conversation_id, window_extension_seconds=window_extension_seconds
+                )
+                call.status = lock_result.get('status')
+            lock_status = lock_result.get('status')
             if lock_status == 'ACQUIRED':
                 logger.info(f"Trigger lock ACQUIRED for {conversation_id}, will send SQS trigger.")
                 should_send_sqs_message = True
+                trigger_delay_seconds = batch_window.choose_delay_seconds(
+                    context_object.get('body'), lock_result.get('batch_stats')
+                )
+                if window_extension_seconds:
+                    # Backlog building up - batch more fragments per trigger
+                    trigger_delay_seconds = min(
+                        trigger_delay_seconds + window_extension_seconds, batch_window.SQS_MAX_DELAY_SECONDS
+                    )
+                    metrics.put_metric('batch_window_extension', window_extension_seconds, metrics.UNIT_SECONDS)
             elif lock_status == 'EXISTS':
                 logger.info(f"Trigger lock already EXISTS for {conversation_id}, skipping SQS send.")
                 should_send_sqs_message = False
@@ -244,7 +409,12 @@ def handler(event, context):
 
         if should_send_sqs_message:
             logger.info(f"Attempting to send message to SQS queue: {target_queue_url}")
-            sqs_send_status = sqs_service.send_message_to_queue(target_queue_url, context_object)
+            with metrics.timer('sqs_send'), admission_controller.track('sqs') as call:
+                sqs_send_status = sqs_service.send_message_to_queue(
+                    target_queue_url, context_object, delay_seconds=trigger_delay_seconds,
+                    window_extension_seconds=fifo_extension_seconds
+                )
+                call.status = sqs_send_status
             if sqs_send_status != 'SUCCESS':
                 logger.error(f"Failed to send message to SQS queue {target_queue_url} for conversation: {conversation_id}. Status: {sqs_send_status}")
                 return _determine_final_error_response(context_object, sqs_send_status, "Failed to queue message")
@@ -254,6 +424,8 @@ def handler(event, context):
 
         # --- Step 8: Acknowledge Success ---
         logger.info(f"Processing complete for conversation {conversation_id}. Sending success acknowledgment.")
+        if keyword_reply:
+            return _keyword_reply_response(context_object.get('channel_type'), keyword_reply, keyword_rules.ACTION_HANDOFF)
         if context_object.get('channel_type') in ['whatsapp', 'sms']:
             return response_builder.create_success_response_twiml()
         else:
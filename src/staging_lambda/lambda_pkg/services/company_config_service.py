@@ -0,0 +1,208 @@
+# webhook_handler/services/company_config_service.py
+"""
+Company/project configuration, read from the company-data table and cached per
+warm container.
+
+Conversation items carry a copy of their company's config taken when the
+conversation was created. When COMPANY_DATA_TABLE_NAME is set, the handler reads
+only the per-conversation fields of the conversation item and takes the config
+from here instead, so a config change applies without rewriting conversations.
+
+Cache entries are version-stamped with the record's `config_version` and
+`updated_at`. After COMPANY_CONFIG_CACHE_TTL_SECONDS an entry is revalidated
+with a projected read of just the version; the full record is only fetched again
+when the version has changed. If revalidation fails, the stale entry is served
+for another TTL rather than failing the request.
+"""
+
+import os
+import time
+import logging
+import threading
+from botocore.exceptions import ClientError
+
+from ..utils import aws_clients, retry_policy
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+
+# --- Status Codes (same contract as the Messaging Lambda's copy) ---
+CONFIG_FOUND = 'FOUND'
+CONFIG_NOT_FOUND = 'NOT_FOUND'
+CONFIG_DISABLED = 'DISABLED'
+CONFIG_DB_ERROR = 'DB_ERROR'
+
+# --- Configuration ---
+COMPANY_DATA_TABLE_NAME = os.environ.get('COMPANY_DATA_TABLE_NAME', '')
+COMPANY_CONFIG_CACHE_TTL_SECONDS = int(os.environ.get('COMPANY_CONFIG_CACHE_TTL_SECONDS', '300'))
+
+# Company-level fields that conversation items also carry a copy of
+CONFIG_FIELDS = (
+    'allowed_channels',
+    'ai_config',
+    'channel_config',
+    'auto_queue_initial_message',
+    'auto_queue_initial_message_from_number',
+    'auto_queue_initial_message_from_email',
+    'auto_queue_reply_message',
+    'auto_queue_reply_message_from_number',
+    'auto_queue_reply_message_from_email',
+    'rate_limits',
+    'keyword_rules',
+    'company_rep',
+    'project_status',
+    'company_name',
+    'project_name',
+)
+
+# channel_config key holding the company's identifier on each channel (the webhook `To`)
+COMPANY_IDENTIFIER_KEYS = {
+    'whatsapp': 'company_whatsapp_number',
+    'sms': 'company_sms_number',
+    'email': 'company_email',
+}
+
+company_data_table = None
+if COMPANY_DATA_TABLE_NAME:
+    try:
+        company_data_table = aws_clients.resource('dynamodb').Table(COMPANY_DATA_TABLE_NAME)
+        logger.info(f"Initialized company config cache for table: {COMPANY_DATA_TABLE_NAME}")
+    except Exception as e:
+        logger.critical(f"Failed to initialize company data table {COMPANY_DATA_TABLE_NAME}: {e}")
+        company_data_table = None
+
+# (company_id, project_id) -> {'record': dict or None, 'version': ..., 'checked_at': epoch}
+_cache = {}
+_lock = threading.Lock()
+
+
+def _version(record):
+    if not record:
+        return None
+    # Both stamps: an edit that kept config_version but moved updated_at still counts
+    return (record.get('config_version'), record.get('updated_at'))
+
+
+def _read(company_id, project_id, version_only=False):
+    """GetItem on the company-data table. Returns (status, item or None)."""
+    kwargs = {'Key': {'company_id': company_id, 'project_id': project_id}}
+    if version_only:
+        kwargs['ProjectionExpression'] = 'config_version, updated_at'
+    try:
+        item = retry_policy.call('dynamodb.get_item', company_data_table.get_item, **kwargs).get('Item')
+    except ClientError as e:
+        logger.error(f"DynamoDB ClientError reading company config {company_id}/{project_id}: {e}")
+        return CONFIG_DB_ERROR, None
+    except Exception as e:
+        logger.exception(f"Unexpected error reading company config {company_id}/{project_id}: {e}")
+        return CONFIG_DB_ERROR, None
+    return (CONFIG_FOUND, item) if item else (CONFIG_NOT_FOUND, None)
+
+
+def _result(entry):
+    if entry['record'] is None:
+        return CONFIG_NOT_FOUND, None
+    return CONFIG_FOUND, entry['record']
+
+
+def get_company_config(company_id, project_id):
+    """
+    Returns the company-data record for a company/project.
+
+    Returns:
+        tuple: (status, record) - status is CONFIG_FOUND, CONFIG_NOT_FOUND (cached too),
+               CONFIG_DISABLED (COMPANY_DATA_TABLE_NAME not configured) or CONFIG_DB_ERROR;
+               record is the company-data record when found, else None.
+    """
+    if not company_data_table:
+        return CONFIG_DISABLED, None
+    if not company_id or not project_id:
+        return CONFIG_NOT_FOUND, None
+
+    key = (company_id, project_id)
+    now = time.time()
+    with _lock:
+        entry = _cache.get(key)
+    if entry and now - entry['checked_at'] < COMPANY_CONFIG_CACHE_TTL_SECONDS:
+        return _result(entry)
+
+    if entry:
+        # Expired - only re-read the full record if its version has moved on
+        status, stamp = _read(company_id, project_id, version_only=True)
+        if status == CONFIG_DB_ERROR:
+            logger.warning(f"Could not revalidate company config {company_id}/{project_id}; serving cached copy")
+            unchanged = True
+        else:
+            unchanged = (stamp is None) == (entry['record'] is None) and _version(stamp) == entry['version']
+        if unchanged:
+            with _lock:
+                entry['checked_at'] = now
+            return _result(entry)
+        logger.info(f"Company config {company_id}/{project_id} changed (version {entry['version']} -> {_version(stamp)}); reloading")
+
+    status, record = _read(company_id, project_id)
+    if status == CONFIG_DB_ERROR:
+        return CONFIG_DB_ERROR, None
+    entry = {'record': record, 'version': _version(record), 'checked_at': now}
+    with _lock:
+        _cache[key] = entry
+    return _result(entry)
+
+
+def channel_view(record, channel):
+    """
+    Flattens a company-data record into the shape conversation items use: `ai_config`
+    and `channel_config` hold only the given channel's settings.
+    """
+    view = {field: record[field] for field in CONFIG_FIELDS
+            if field in record and field not in ('ai_config', 'channel_config')}
+    ai_config = ((record.get('ai_config') or {}).get('openai_config') or {}).get(channel)
+    if ai_config:
+        view['ai_config'] = ai_config
+    channel_config = (record.get('channel_config') or {}).get(channel)
+    if channel_config:
+        view['channel_config'] = channel_config
+    return view
+
+
+def load_company_identifiers():
+    """
+    Scans the company-data table for every company's channel identifiers.
+
+    Returns:
+        dict: {channel: set of identifiers} (e.g. {'whatsapp': {'+447...'}}), or None if
+              the table is not configured or the scan failed.
+    """
+    if not company_data_table:
+        return None
+    identifiers = {channel: set() for channel in COMPANY_IDENTIFIER_KEYS}
+    scan_kwargs = {'ProjectionExpression': 'channel_config'}
+    try:
+        while True:
+            response = retry_policy.call('dynamodb.scan', company_data_table.scan, **scan_kwargs)
+            for item in response.get('Items', []):
+                channel_config = item.get('channel_config') or {}
+                for channel, key in COMPANY_IDENTIFIER_KEYS.items():
+                    value = (channel_config.get(channel) or {}).get(key)
+                    if value:
+                        identifiers[channel].add(value)
+            if 'LastEvaluatedKey' not in response:
+                break
+            scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    except ClientError as e:
+        logger.error(f"DynamoDB ClientError scanning company identifiers from {COMPANY_DATA_TABLE_NAME}: {e}")
+        return None
+    except Exception as e:
+        logger.exception(f"Unexpected error scanning company identifiers from {COMPANY_DATA_TABLE_NAME}: {e}")
+        return None
+    logger.info(f"Loaded company identifiers: { {channel: len(values) for channel, values in identifiers.items()} }")
+    return identifiers
+
+
+def invalidate(company_id=None, project_id=None):
+    """Drops cached config for one company/project, or everything if called without arguments."""
+    with _lock:
+        if company_id is None:
+            _cache.clear()
+        else:
+            _cache.pop((company_id, project_id), None)
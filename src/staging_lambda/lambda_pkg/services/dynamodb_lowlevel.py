@@ -0,0 +1,203 @@
+# webhook_handler/services/dynamodb_lowlevel.py
+
+"""
+Thin data access on the low-level DynamoDB client, for the calls made on every
+request.
+
+The resource layer (Table.get_item etc.) runs boto3's TypeSerializer /
+TypeDeserializer over every attribute through botocore event handlers, and
+callers rebuild their expression strings per call. Here:
+
+    * Items, keys and expression values are marshalled by serialize() /
+      deserialize(), which dispatch on the exact Python type. The result is the
+      same as boto3's: numbers go through DYNAMODB_CONTEXT on the way in (so
+      floats, NaN and out-of-range Decimals are rejected exactly as boto3 rejects
+      them), and come back as Decimal; binary comes back as boto3 Binary.
+    * Expression strings and name maps are built once per shape and cached
+      (projection(), plus the per-function templates in dynamodb_service).
+
+    item = dynamodb_lowlevel.get_item(dynamodb_client, conversations_table.name, key, attributes=CONVERSATION_FIELDS)
+
+Functions take the client and table name and raise ClientError like the
+client does, so callers keep their retry_policy.call() wrapping and error
+mapping unchanged.
+"""
+
+import functools
+from decimal import Decimal
+
+from boto3.dynamodb.types import Binary, DYNAMODB_CONTEXT
+
+_FLOAT_ERROR = "Float types are not supported. Use Decimal types instead."
+# Integers below this need no DYNAMODB_CONTEXT check (38 significant digits)
+_MAX_EXACT_INT = 10 ** 38
+
+
+# --- Marshalling ---
+
+def _serialize_number(value):
+    number = str(DYNAMODB_CONTEXT.create_decimal(value))
+    if number in ('Infinity', 'NaN'):
+        raise TypeError("Infinity and NaN not supported")
+    return {'N': number}
+
+
+def _serialize_int(value):
+    if -_MAX_EXACT_INT < value < _MAX_EXACT_INT:
+        return {'N': str(value)}
+    return _serialize_number(value)
+
+
+def _serialize_float(value):
+    raise TypeError(_FLOAT_ERROR)
+
+
+def _serialize_set(value):
+    # Same precedence as TypeSerializer: number set, string set, binary set
+    values = list(value)
+    if any(isinstance(v, float) for v in values):
+        raise TypeError(_FLOAT_ERROR)
+    if all(isinstance(v, (int, Decimal)) for v in values):
+        return {'NS': [_serialize_number(v)['N'] for v in values]}
+    if all(isinstance(v, str) for v in values):
+        return {'SS': values}
+    if all(isinstance(v, (bytes, bytearray, Binary)) for v in values):
+        return {'BS': [_serialize_binary(v)['B'] for v in values]}
+    raise TypeError(f"Unsupported type \"{type(value)}\" for value \"{value}\"")
+
+
+def _serialize_binary(value):
+    return {'B': value.value if isinstance(value, Binary) else bytes(value)}
+
+
+_SERIALIZERS = {
+    str: lambda value: {'S': value},
+    bool: lambda value: {'BOOL': value},
+    int: _serialize_int,
+    Decimal: _serialize_number,
+    float: _serialize_float,
+    type(None): lambda value: {'NULL': True},
+    dict: lambda value: {'M': {k: serialize(v) for k, v in value.items()}},
+    list: lambda value: {'L': [serialize(v) for v in value]},
+    tuple: lambda value: {'L': [serialize(v) for v in value]},
+    set: _serialize_set,
+    frozenset: _serialize_set,
+    bytes: _serialize_binary,
+    bytearray: _serialize_binary,
+    Binary: _serialize_binary,
+}
+# Subclasses (e.g. IntEnum, OrderedDict) in the order boto3 checks them
+_FALLBACK_ORDER = (bool, str, int, Decimal, float, bytes, bytearray, Binary, dict, set, frozenset, list, tuple)
+
+
+def serialize(value):
+    """Python value -> DynamoDB AttributeValue, as boto3's TypeSerializer would produce."""
+    serializer = _SERIALIZERS.get(type(value))
+    if serializer is None:
+        for base in _FALLBACK_ORDER:
+            if isinstance(value, base):
+                serializer = _SERIALIZERS[base]
+                break
+        else:
+            raise TypeError(f"Unsupported type \"{type(value)}\" for value \"{value}\"")
+    return serializer(value)
+
+
+_DESERIALIZERS = {
+    'S': lambda value: value,
+    'N': Decimal,
+    'BOOL': lambda value: value,
+    'NULL': lambda value: None,
+    'M': lambda value: {k: deserialize(v) for k, v in value.items()},
+    'L': lambda value: [deserialize(v) for v in value],
+    'SS': set,
+    'NS': lambda value: {Decimal(v) for v in value},
+    'B': Binary,
+    'BS': lambda value: {Binary(v) for v in value},
+}
+
+
+def deserialize(attribute_value):
+    """DynamoDB AttributeValue -> Python value, as boto3's TypeDeserializer would produce."""
+    for type_code, value in attribute_value.items():
+        return _DESERIALIZERS[type_code](value)
+    raise TypeError("Value must be a nonempty dictionary whose key is a valid dynamodb type.")
+
+
+def serialize_item(item):
+    return {k: serialize(v) for k, v in item.items()}
+
+
+def deserialize_item(attribute_values):
+    return {k: deserialize(v) for k, v in attribute_values.items()}
+
+
+# --- Expression templates ---
+
+@functools.lru_cache(maxsize=64)
+def projection(attributes):
+    """(ProjectionExpression, ExpressionAttributeNames) for a tuple of attribute names."""
+    names = {f"#a{i}": name for i, name in enumerate(attributes)}
+    return ', '.join(names), names
+
+
+# --- Operations ---
+
+def get_item(client, table_name, key, consistent_read=False, attributes=None):
+    """GetItem. Returns the item, or None if there is none."""
+    request = {'TableName': table_name, 'Key': serialize_item(key)}
+    if consistent_read:
+        request['ConsistentRead'] = True
+    if attributes:
+        request['ProjectionExpression'], request['ExpressionAttributeNames'] = projection(tuple(attributes))
+    item = client.get_item(**request).get('Item')
+    return deserialize_item(item) if item else None
+
+
+def query(client, table_name, key_condition, values, index_name=None, names=None,
+          projection_expression=None, consistent_read=False, limit=None):
+    """Query (a single page). Returns the list of items."""
+    request = {
+        'TableName': table_name,
+        'KeyConditionExpression': key_condition,
+        'ExpressionAttributeValues': serialize_item(values),
+    }
+    if index_name:
+        request['IndexName'] = index_name
+    if names:
+        request['ExpressionAttributeNames'] = names
+    if projection_expression:
+        request['ProjectionExpression'] = projection_expression
+    if consistent_read:
+        request['ConsistentRead'] = True
+    if limit:
+        request['Limit'] = limit
+    return [deserialize_item(item) for item in client.query(**request).get('Items', [])]
+
+
+def put_item(client, table_name, item, condition=None, names=None, values=None):
+    """PutItem."""
+    request = {'TableName': table_name, 'Item': serialize_item(item)}
+    if condition:
+        request['ConditionExpression'] = condition
+    if names:
+        request['ExpressionAttributeNames'] = names
+    if values:
+        request['ExpressionAttributeValues'] = serialize_item(values)
+    client.put_item(**request)
+
+
+def update_item(client, table_name, key, update_expression, condition=None, names=None,
+                values=None, return_values=None):
+    """UpdateItem. Returns the requested attributes (empty dict when none are returned)."""
+    request = {'TableName': table_name, 'Key': serialize_item(key), 'UpdateExpression': update_expression}
+    if condition:
+        request['ConditionExpression'] = condition
+    if names:
+        request['ExpressionAttributeNames'] = names
+    if values:
+        request['ExpressionAttributeValues'] = serialize_item(values)
+    if return_values:
+        request['ReturnValues'] = return_values
+    attributes = client.update_item(**request).get('Attributes')
+    return deserialize_item(attributes) if attributes else {}
@@ -3,9 +3,11 @@ import os
 import time
 import datetime
 import logging
-import boto3
 from botocore.exceptions import ClientError
 
+from . import dynamodb_lowlevel
+from ..utils import aws_clients, retry_policy
+
 logger = logging.getLogger(__name__)
 logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
 
@@ -14,8 +16,27 @@ STAGE_TABLE_NAME = os.environ.get('STAGE_TABLE_NAME', 'conversations-stage-test'
 LOCK_TABLE_NAME = os.environ.get('LOCK_TABLE_NAME', 'conversations-trigger-lock-test')
 # Batch window (W) in seconds - SQS DelaySeconds
 BATCH_WINDOW_SECONDS = int(os.environ.get('BATCH_WINDOW_SECONDS', '10'))
+# Upper bound of the adaptive batch window (core/batch_window.py) - TTLs must outlive the longest delay
+MAX_BATCH_WINDOW_SECONDS = max(int(os.environ.get('MAX_BATCH_WINDOW_SECONDS', '20')), BATCH_WINDOW_SECONDS)
 # Safety buffer for TTL calculations
 TTL_BUFFER_SECONDS = int(os.environ.get('TTL_BUFFER_SECONDS', '60'))
+# Trigger-lock items also carry the per-conversation batch timing stats, so they live much longer
+BATCH_STATS_TTL_SECONDS = int(os.environ.get('BATCH_STATS_TTL_SECONDS', str(7 * 24 * 3600)))
+
+# Per-conversation attributes of a conversation item. When company config comes from
+# company_config_service, only these are read (the item's copy of the config is skipped,
+# and so is the message history, which the staging path never uses)
+CONVERSATION_FIELDS = (
+    'primary_channel', 'conversation_id', 'company_id', 'project_id', 'request_id',
+    'channel_method', 'conversation_status', 'hand_off_to_human', 'hand_off_to_human_reason',
+    'task_complete', 'thread_id', 'recipient_tel', 'recipient_email', 'recipient_first_name',
+    'recipient_last_name', 'comms_consent', 'created_at', 'updated_at'
+)
+
+# Counters kept on the trigger-lock item (written by MessagingLambda on release)
+BATCH_STAT_FIELDS = (
+    'batch_count', 'fragment_count', 'gap_sum_ms', 'gap_count', 'split_count', 'last_fragment_at_ms'
+)
 
 # --- Boto3 Initialization & Error Code Lists ---
 transient_ddb_errors = [
@@ -34,7 +55,9 @@ conversations_table = None # Add variable for conversations table
 CONVERSATIONS_TABLE_NAME = os.environ.get('CONVERSATIONS_TABLE_NAME', 'ai-multi-comms-conversations-dev') # Added conversations table name
 
 try:
-    dynamodb = boto3.resource('dynamodb')
+    dynamodb = aws_clients.resource('dynamodb')
+    # Per-request calls go through dynamodb_lowlevel on the plain (wire-format) client
+    dynamodb_client = aws_clients.client('dynamodb')
     stage_table = dynamodb.Table(STAGE_TABLE_NAME)
     lock_table = dynamodb.Table(LOCK_TABLE_NAME)
     conversations_table = dynamodb.Table(CONVERSATIONS_TABLE_NAME) # Initialize conversations table
@@ -66,6 +89,13 @@ GSI_CONFIG = {
     }
     # Add other channels here
 }
+# Expressions are built once, not per request
+for _gsi in GSI_CONFIG.values():
+    _gsi['key_condition'] = f"{_gsi['pk_name']} = :pk AND {_gsi['sk_name']} = :sk"
+GSI_PROJECTION = 'channel_config, conversation_id, company_id, project_id'
+TRIGGER_LOCK_UPDATE = 'SET trigger_expires_at = :trigger_exp, expires_at = :exp'
+TRIGGER_LOCK_CONDITION = 'attribute_not_exists(trigger_expires_at) OR trigger_expires_at < :now'
+COMMS_CONSENT_UPDATE = 'SET comms_consent = :consent, comms_consent_updated_at = :now, comms_consent_source = :source'
 
 def get_credential_ref_for_validation(channel_type, from_id, to_id):
     """
@@ -79,7 +109,8 @@ def get_credential_ref_for_validation(channel_type, from_id, to_id):
 
     Returns:
         dict: A dictionary containing:
-              {'status': 'FOUND', 'credential_ref': 'secret_id_value', 'conversation_id': 'conv_id'} on success.
+              {'status': 'FOUND', 'credential_ref': 'secret_id_value', 'conversation_id': 'conv_id',
+               'company_id': ..., 'project_id': ...} on success.
               {'status': 'NOT_FOUND'} if no matching record.
               {'status': 'MISSING_CREDENTIAL_CONFIG'} if record found but key missing.
               {'status': 'UNSUPPORTED_CHANNEL'} if channel_type is invalid.
@@ -115,19 +146,15 @@ def get_credential_ref_for_validation(channel_type, from_id, to_id):
     logger.info(f"Querying GSI '{index_name}' on table '{CONVERSATIONS_TABLE_NAME}' with {pk_name}={gsi_pk_value}, {sk_name}={gsi_sk_value}")
 
     try:
-        response = conversations_table.query(
-            IndexName=index_name,
-            KeyConditionExpression=f'{pk_name} = :pk AND {sk_name} = :sk',
-            ExpressionAttributeValues={
-                ':pk': gsi_pk_value,
-                ':sk': gsi_sk_value
-            },
-            ProjectionExpression='channel_config, conversation_id', # Fetch ONLY channel_config and conversation_id
-            Limit=1
+        items = retry_policy.call(
+            'dynamodb.query', dynamodb_lowlevel.query, dynamodb_client, conversations_table.name,
+            config['key_condition'],
+            {':pk': gsi_pk_value, ':sk': gsi_sk_value},
+            index_name=index_name,
+            projection_expression=GSI_PROJECTION, # Credential ref plus the keys for the config cache
+            limit=1
         )
 
-        items = response.get('Items', [])
-
         if not items:
             logger.warning(f"No record found in GSI '{index_name}' for {pk_name}={gsi_pk_value}, {sk_name}={gsi_sk_value}")
             return {'status': 'NOT_FOUND'}
@@ -145,7 +172,9 @@ def get_credential_ref_for_validation(channel_type, from_id, to_id):
         return {
             'status': 'FOUND',
             'credential_ref': credential_ref,
-            'conversation_id': conversation_id
+            'conversation_id': conversation_id,
+            'company_id': item.get('company_id'),
+            'project_id': item.get('project_id')
         }
 
     except ClientError as e:
@@ -163,13 +192,15 @@ def get_credential_ref_for_validation(channel_type, from_id, to_id):
         logger.exception(f"Unexpected error querying GSI '{index_name}' for {gsi_pk_value}/{gsi_sk_value}")
         return {'status': 'INTERNAL_ERROR'}
 
-def get_full_conversation(primary_channel, conversation_id):
+def get_full_conversation(primary_channel, conversation_id, attributes=None):
     """
     Retrieves the full conversation item from the main table using its composite PK.
 
     Args:
         primary_channel (str): The partition key value.
         conversation_id (str): The sort key value.
+        attributes (tuple): Optional attribute names to read instead of the whole item
+                            (e.g. CONVERSATION_FIELDS).
 
     Returns:
         dict: A dictionary containing:
@@ -187,15 +218,12 @@ def get_full_conversation(primary_channel, conversation_id):
 
     logger.info(f"Attempting to get full conversation item for PK={primary_channel}, SK={conversation_id} from {CONVERSATIONS_TABLE_NAME}")
     try:
-        response = conversations_table.get_item(
-            Key={
-                'primary_channel': primary_channel,
-                'conversation_id': conversation_id
-                }
+        item = retry_policy.call(
+            'dynamodb.get_item', dynamodb_lowlevel.get_item, dynamodb_client, conversations_table.name,
+            {'primary_channel': primary_channel, 'conversation_id': conversation_id},
+            attributes=attributes
         )
 
-        item = response.get('Item')
-
         if not item:
             logger.warning(f"No conversation record found for PK={primary_channel}, SK={conversation_id}")
             return {'status': 'NOT_FOUND'}
@@ -220,9 +248,11 @@ def get_full_conversation(primary_channel, conversation_id):
 
 # --- Service Functions ---
 
-def write_to_stage_table(context_object):
+def write_to_stage_table(context_object, window_extension_seconds=0):
     """
     Writes the essential message fragment details to the staging table.
+    `window_extension_seconds` is added to the TTL when the batch window is being
+    lengthened under load (see core.admission_controller).
     Returns a status code string: 'SUCCESS', 'STAGE_DB_TRANSIENT_ERROR',
     'STAGE_DB_CONFIG_ERROR', 'STAGE_DB_VALIDATION_ERROR', 'STAGE_WRITE_ERROR', or 'INTERNAL_ERROR'.
     """
@@ -240,8 +270,10 @@ def write_to_stage_table(context_object):
         return 'INTERNAL_ERROR' # Or a new code like 'BAD_INPUT'
 
     try:
-        current_time_epoch = int(time.time())
-        expires_at = current_time_epoch + BATCH_WINDOW_SECONDS + TTL_BUFFER_SECONDS
+        current_time = time.time()
+        current_time_epoch = int(current_time)
+        # The batch window is chosen after staging, so cover the longest possible window
+        expires_at = current_time_epoch + MAX_BATCH_WINDOW_SECONDS + window_extension_seconds + TTL_BUFFER_SECONDS
         # Use consistent timestamp for received_at and TTL calculation base
         received_at_iso = datetime.datetime.fromtimestamp(current_time_epoch).isoformat()
 
@@ -251,6 +283,7 @@ def write_to_stage_table(context_object):
             'primary_channel': context_object.get('primary_channel'), # Company channel identifier
             'body': context_object.get('body'),
             'received_at': received_at_iso,
+            'received_at_ms': int(current_time * 1000), # Millisecond precision for batch gap stats
             'expires_at': expires_at
         }
 
@@ -258,7 +291,7 @@ def write_to_stage_table(context_object):
         stage_item = {k: v for k, v in stage_item.items() if v is not None}
 
         logger.debug(f"Attempting to write to stage table ({STAGE_TABLE_NAME}): {stage_item}")
-        stage_table.put_item(Item=stage_item)
+        retry_policy.call('dynamodb.put_item', dynamodb_lowlevel.put_item, dynamodb_client, stage_table.name, stage_item)
         logger.info(f"Successfully staged message {message_sid} for conversation {conversation_id}")
         return 'SUCCESS'
 
@@ -278,50 +311,228 @@ def write_to_stage_table(context_object):
         return 'INTERNAL_ERROR'
 
 
-def acquire_trigger_lock(conversation_id):
+def acquire_trigger_lock(conversation_id, window_extension_seconds=0):
     """
     Attempts to acquire the trigger scheduling lock for a conversation.
-    Returns a status code string: 'ACQUIRED', 'EXISTS', 'TRIGGER_DB_TRANSIENT_ERROR',
-    'TRIGGER_DB_CONFIG_ERROR', 'TRIGGER_DB_VALIDATION_ERROR', 'TRIGGER_LOCK_WRITE_ERROR', or 'INTERNAL_ERROR'.
+
+    The lock item is long-lived: it also stores the conversation's batch timing
+    stats (BATCH_STAT_FIELDS). A trigger is pending while `trigger_expires_at` is
+    set and in the future; MessagingLambda removes it once the batch is processed.
+    The previous item is returned in the same round trip so the caller can pick an
+    adaptive batch window from the stats. `window_extension_seconds` lengthens the
+    safety expiry to match a batch window extended under load.
+
+    Returns:
+        dict: {'status': 'ACQUIRED', 'batch_stats': {...}} on success.
+              {'status': 'EXISTS'} if a trigger is already pending.
+              {'status': <error code>} on failure - 'TRIGGER_DB_TRANSIENT_ERROR',
+              'TRIGGER_DB_CONFIG_ERROR', 'TRIGGER_DB_VALIDATION_ERROR',
+              'TRIGGER_LOCK_WRITE_ERROR' or 'INTERNAL_ERROR'.
     """
     if not conversation_id:
         logger.error("acquire_trigger_lock called with empty conversation_id.")
-        return 'INTERNAL_ERROR' # Or 'BAD_INPUT'
+        return {'status': 'INTERNAL_ERROR'} # Or 'BAD_INPUT'
 
     try:
         current_time_epoch = int(time.time())
-        # TTL ensures lock eventually expires even if MessagingLambda fails cleanup
-        expires_at = current_time_epoch + BATCH_WINDOW_SECONDS + TTL_BUFFER_SECONDS
-
-        lock_item = {
-            'conversation_id': conversation_id,
-            'expires_at': expires_at
-        }
+        # Safety expiry in case MessagingLambda never releases the trigger
+        trigger_expires_at = current_time_epoch + MAX_BATCH_WINDOW_SECONDS + window_extension_seconds + TTL_BUFFER_SECONDS
+        # TTL keeps the stats for active conversations only
+        expires_at = current_time_epoch + BATCH_STATS_TTL_SECONDS
 
         logger.debug(f"Attempting to acquire trigger lock for {conversation_id} in {LOCK_TABLE_NAME}")
-        lock_table.put_item(
-            Item=lock_item,
-            ConditionExpression='attribute_not_exists(conversation_id)'
+        # Conditional write - only throttling errors are retried
+        old_item = retry_policy.call(
+            'dynamodb.update_item', dynamodb_lowlevel.update_item, dynamodb_client, lock_table.name,
+            {'conversation_id': conversation_id},
+            TRIGGER_LOCK_UPDATE,
+            condition=TRIGGER_LOCK_CONDITION,
+            values={
+                ':trigger_exp': trigger_expires_at,
+                ':exp': expires_at,
+                ':now': current_time_epoch
+            },
+            return_values='ALL_OLD',
+            idempotent=False
         )
+        batch_stats = {k: old_item[k] for k in BATCH_STAT_FIELDS if k in old_item}
         logger.info(f"Successfully acquired trigger lock for conversation {conversation_id}")
-        return 'ACQUIRED'
+        return {'status': 'ACQUIRED', 'batch_stats': batch_stats}
 
     except ClientError as e:
         aws_error_code = e.response.get('Error', {}).get('Code')
         if aws_error_code == 'ConditionalCheckFailedException':
             logger.info(f"Trigger lock already exists for conversation {conversation_id}. Condition check failed.")
-            return 'EXISTS'
+            return {'status': 'EXISTS'}
         else:
             logger.error(f"DynamoDB ClientError acquiring trigger lock for {conversation_id}: {aws_error_code} - {e}")
             # Map specific AWS errors to our internal codes
             if aws_error_code in transient_ddb_errors:
-                return 'TRIGGER_DB_TRANSIENT_ERROR'
+                return {'status': 'TRIGGER_DB_TRANSIENT_ERROR'}
             elif aws_error_code in config_ddb_errors:
-                return 'TRIGGER_DB_CONFIG_ERROR'
+                return {'status': 'TRIGGER_DB_CONFIG_ERROR'}
             elif aws_error_code in validation_ddb_errors:
-                return 'TRIGGER_DB_VALIDATION_ERROR'
+                return {'status': 'TRIGGER_DB_VALIDATION_ERROR'}
             else:
-                return 'TRIGGER_LOCK_WRITE_ERROR'
+                return {'status': 'TRIGGER_LOCK_WRITE_ERROR'}
     except Exception as e:
         logger.exception(f"Unexpected error acquiring trigger lock for {conversation_id}")
-        return 'INTERNAL_ERROR' 
\ No newline at end of file
+        return {'status': 'INTERNAL_ERROR'}
+
+
+def record_late_fragment(conversation_id):
+    """
+    Counts a fragment that arrived after its batch window had closed (the
+    conversation was already processing a reply). Feeds the adaptive batch window.
+
+    Best effort: returns True on success, False on any error.
+    """
+    if not conversation_id:
+        return False
+
+    try:
+        # Counter write - only throttling errors are retried
+        retry_policy.call(
+            'dynamodb.update_item', lock_table.update_item, idempotent=False,
+            Key={'conversation_id': conversation_id},
+            UpdateExpression='SET expires_at = :exp ADD split_count :one',
+            ExpressionAttributeValues={
+                ':exp': int(time.time()) + BATCH_STATS_TTL_SECONDS,
+                ':one': 1
+            }
+        )
+        logger.info(f"Recorded late fragment for conversation {conversation_id}")
+        return True
+    except Exception as e:
+        logger.warning(f"Failed to record late fragment for {conversation_id}: {e}")
+        return False
+
+
+def set_comms_consent(primary_channel, conversation_id, consent, source):
+    """
+    Records an opt-out / opt-in on the conversation item (comms_consent plus when and
+    why it changed). Used by the keyword fast path (core/keyword_rules.py).
+
+    Returns:
+        str: 'SUCCESS', 'NOT_FOUND' if the conversation no longer exists, or an error
+             code - 'DB_TRANSIENT_ERROR', 'DB_CONFIG_ERROR', 'DB_VALIDATION_ERROR',
+             'DB_UPDATE_ERROR' or 'INTERNAL_ERROR'.
+    """
+    if not primary_channel or not conversation_id:
+        logger.error(f"set_comms_consent called with empty primary_channel ('{primary_channel}') or conversation_id ('{conversation_id}').")
+        return 'INTERNAL_ERROR'
+
+    try:
+        # Setting the same values twice is harmless, so throttling and server errors are retried
+        retry_policy.call(
+            'dynamodb.update_item', dynamodb_lowlevel.update_item, dynamodb_client, conversations_table.name,
+            {'primary_channel': primary_channel, 'conversation_id': conversation_id},
+            COMMS_CONSENT_UPDATE,
+            condition='attribute_exists(conversation_id)',
+            values={
+                ':consent': bool(consent),
+                ':now': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                ':source': source
+            }
+        )
+        logger.info(f"Set comms_consent={bool(consent)} on conversation {conversation_id} ({source})")
+        return 'SUCCESS'
+
+    except ClientError as e:
+        aws_error_code = e.response.get('Error', {}).get('Code')
+        if aws_error_code == 'ConditionalCheckFailedException':
+            logger.warning(f"Conversation {primary_channel}/{conversation_id} not found when setting comms_consent")
+            return 'NOT_FOUND'
+        logger.error(f"DynamoDB ClientError setting comms_consent for {conversation_id}: {aws_error_code} - {e}")
+        if aws_error_code in transient_ddb_errors:
+            return 'DB_TRANSIENT_ERROR'
+        elif aws_error_code in config_ddb_errors:
+            return 'DB_CONFIG_ERROR'
+        elif aws_error_code in validation_ddb_errors:
+            return 'DB_VALIDATION_ERROR'
+        else:
+            return 'DB_UPDATE_ERROR'
+    except Exception as e:
+        logger.exception(f"Unexpected error setting comms_consent for {conversation_id}")
+        return 'INTERNAL_ERROR'
+
+
+def reserve_rate_limit_tokens(counter_key, amount, limit, expires_at):
+    """
+    Atomically adds `amount` requests to a time-bucketed rate-limit counter, unless
+    that would take the counter past `limit`.
+
+    Counter items live in the trigger-lock table under a 'ratelimit#...' key and are
+    removed by the table's TTL once their time bucket has passed.
+
+    Returns:
+        dict: {'status': 'RESERVED', 'count': new_count} on success.
+              {'status': 'LIMIT_EXCEEDED'} if the reservation does not fit.
+              {'status': <error code>} on failure - 'RATE_LIMIT_DB_TRANSIENT_ERROR',
+              'RATE_LIMIT_DB_CONFIG_ERROR', 'RATE_LIMIT_DB_VALIDATION_ERROR',
+              'RATE_LIMIT_WRITE_ERROR' or 'INTERNAL_ERROR'.
+    """
+    if not counter_key or amount < 1 or amount > limit:
+        logger.error(f"reserve_rate_limit_tokens called with invalid arguments: key='{counter_key}', amount={amount}, limit={limit}")
+        return {'status': 'INTERNAL_ERROR'}
+
+    try:
+        response = retry_policy.call(
+            'dynamodb.update_item', lock_table.update_item, idempotent=False,
+            Key={'conversation_id': counter_key},
+            UpdateExpression='SET expires_at = if_not_exists(expires_at, :exp) ADD request_count :n',
+            ConditionExpression='attribute_not_exists(request_count) OR request_count <= :max_before',
+            ExpressionAttributeValues={
+                ':n': amount,
+                ':max_before': limit - amount,
+                ':exp': expires_at
+            },
+            ReturnValues='UPDATED_NEW'
+        )
+        count = int(response.get('Attributes', {}).get('request_count', amount))
+        logger.debug(f"Reserved {amount} rate-limit tokens on {counter_key} (count now {count}/{limit})")
+        return {'status': 'RESERVED', 'count': count}
+
+    except ClientError as e:
+        aws_error_code = e.response.get('Error', {}).get('Code')
+        if aws_error_code == 'ConditionalCheckFailedException':
+            logger.info(f"Rate limit counter {counter_key} cannot take {amount} more requests (limit {limit})")
+            return {'status': 'LIMIT_EXCEEDED'}
+        logger.error(f"DynamoDB ClientError updating rate limit counter {counter_key}: {aws_error_code} - {e}")
+        if aws_error_code in transient_ddb_errors:
+            return {'status': 'RATE_LIMIT_DB_TRANSIENT_ERROR'}
+        elif aws_error_code in config_ddb_errors:
+            return {'status': 'RATE_LIMIT_DB_CONFIG_ERROR'}
+        elif aws_error_code in validation_ddb_errors:
+            return {'status': 'RATE_LIMIT_DB_VALIDATION_ERROR'}
+        else:
+            return {'status': 'RATE_LIMIT_WRITE_ERROR'}
+    except Exception as e:
+        logger.exception(f"Unexpected error updating rate limit counter {counter_key}")
+        return {'status': 'INTERNAL_ERROR'}
+
+
+def release_rate_limit_tokens(counter_key, amount):
+    """
+    Gives back `amount` requests reserved on a rate-limit counter, e.g. when another
+    window of the same request was over its limit.
+
+    Returns:
+        bool: True if the counter was decremented, False otherwise.
+    """
+    try:
+        retry_policy.call(
+            'dynamodb.update_item', lock_table.update_item, idempotent=False,
+            Key={'conversation_id': counter_key},
+            UpdateExpression='ADD request_count :n',
+            ConditionExpression='request_count >= :amount',
+            ExpressionAttributeValues={':n': -amount, ':amount': amount}
+        )
+        logger.debug(f"Released {amount} rate-limit tokens on {counter_key}")
+        return True
+    except ClientError as e:
+        logger.warning(f"Could not release {amount} rate-limit tokens on {counter_key}: {e.response.get('Error', {}).get('Code')}")
+        return False
+    except Exception:
+        logger.exception(f"Unexpected error releasing rate limit tokens on {counter_key}")
+        return False
@@ -1,9 +1,10 @@
-import boto3
 import json
 import logging
 import os
 from botocore.exceptions import ClientError
 
+from ..utils import aws_clients, retry_policy
+
 logger = logging.getLogger(__name__)
 logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
 
@@ -14,7 +15,7 @@ def _get_secrets_manager_client():
     global secrets_manager
     if secrets_manager is None:
         logger.info("Initializing Secrets Manager client.")
-        secrets_manager = boto3.client('secretsmanager', region_name=os.environ.get('AWS_REGION', 'eu-north-1'))
+        secrets_manager = aws_clients.client('secretsmanager')
     return secrets_manager
 
 def get_twilio_auth_token(secret_id):
@@ -31,7 +32,7 @@ def get_twilio_auth_token(secret_id):
     logger.info(f"Attempting to retrieve secret: {secret_id}")
 
     try:
-        get_secret_value_response = client.get_secret_value(SecretId=secret_id)
+        get_secret_value_response = retry_policy.call('secretsmanager.get_secret_value', client.get_secret_value, SecretId=secret_id)
         logger.debug("Successfully retrieved secret value.")
 
         if 'SecretString' in get_secret_value_response:
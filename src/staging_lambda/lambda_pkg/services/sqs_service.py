@@ -1,16 +1,23 @@
 # webhook_handler/services/sqs_service.py
 import os
 import json
+import time
+import hashlib
 import logging
-import boto3
 from botocore.exceptions import ClientError
 
+from ..utils import aws_clients, payload_codec, retry_policy
+
 logger = logging.getLogger(__name__)
 logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
 
 # --- Configuration ---
-# Batch window (W) in seconds - SQS DelaySeconds
+# Batch window (W) in seconds - default SQS DelaySeconds when the caller doesn't choose one
 BATCH_WINDOW_SECONDS = int(os.environ.get('BATCH_WINDOW_SECONDS', '10'))
+# SQS hard limit for DelaySeconds
+SQS_MAX_DELAY_SECONDS = 900
+# SQS limit for MessageGroupId / MessageDeduplicationId
+FIFO_MAX_ID_LENGTH = 128
 HANDOFF_QUEUE_URL = os.environ.get("HANDOFF_QUEUE_URL") # Required
 
 # Ensure handoff queue URL is configured
@@ -25,6 +32,7 @@ transient_sqs_errors = [
     'ServiceUnavailable',
     'InternalFailure',
     'ThrottlingException', # Less common for SendMessage but possible
+    'RequestThrottled',
     # Consider specific network-related errors if boto3/botocore surfaces them
 ]
 # Define potential configuration/parameter SQS errors
@@ -42,7 +50,7 @@ parameter_sqs_errors = [
 
 # --- Boto3 Initialization ---
 try:
-    sqs = boto3.client('sqs')
+    sqs = aws_clients.client('sqs')
     logger.info("Initialized SQS client service.")
 except Exception as e:
     logger.critical(f"Failed to initialize SQS client: {e}")
@@ -50,18 +58,62 @@ except Exception as e:
 
 # --- Service Functions ---
 
-def send_message_to_queue(target_queue_url, context_object):
+def is_fifo_queue(queue_url):
+    """FIFO queue names (and so their URLs) end in '.fifo'."""
+    return bool(queue_url) and queue_url.endswith('.fifo')
+
+
+def _fifo_id(value):
+    """A MessageGroupId / MessageDeduplicationId within SQS's length limit."""
+    return value if len(value) <= FIFO_MAX_ID_LENGTH else hashlib.sha256(value.encode('utf-8')).hexdigest()
+
+
+def fifo_trigger_window(window_seconds, now_ms=None):
+    """
+    The batch window a FIFO trigger sent now belongs to.
+
+    Windows are aligned to multiples of window_seconds, so every fragment of a
+    conversation sent within one window maps to the same deduplication ID and
+    SQS keeps only the first trigger. Returns (window_index, deadline_ms), the
+    deadline being the end of the window - the messaging Lambda doesn't merge
+    the batch before then, so fragments deduplicated into this trigger are
+    always staged by the time it runs.
+    """
+    window_ms = max(1, int(window_seconds)) * 1000
+    now_ms = int(time.time() * 1000) if now_ms is None else now_ms
+    window_index = now_ms // window_ms
+    return window_index, (window_index + 1) * window_ms
+
+
+def send_message_to_queue(target_queue_url, context_object, delay_seconds=None, window_extension_seconds=0):
     """
     Sends a message to the specified SQS queue.
     Returns a status code string: 'SUCCESS', 'SQS_TRANSIENT_ERROR',
-    'SQS_CONFIG_ERROR', 'SQS_PARAMETER_ERROR', 'SQS_SEND_ERROR', or 'INTERNAL_ERROR'.
+    'SQS_CONFIG_ERROR', 'SQS_PARAMETER_ERROR', 'SQS_SEND_ERROR',
+    'PAYLOAD_STORE_TRANSIENT_ERROR', 'PAYLOAD_STORE_ERROR', or 'INTERNAL_ERROR'.
 
     Determines message format and delay based on whether the target is
-    the Human Handoff queue or a Channel Queue.
+    the Human Handoff queue or a Channel Queue. The Handoff Queue gets the full
+    context through utils/payload_codec.py (compressed or claim-checked when
+    large - consumers read it with payload_codec.decode).
+
+    FIFO channel queues don't take a per-message DelaySeconds. Their triggers
+    go to MessageGroupId=conversation_id with a deduplication ID for the
+    conversation's current batch window (fifo_trigger_window), and carry the
+    window end as batch_deadline_ms; the queue's own DelaySeconds holds them
+    back, and the messaging Lambda waits out whatever is left of the window.
+    An admission extension moves only the deadline, never the window, so every
+    fragment of a window keeps one deduplication ID whatever its extension.
 
     Args:
         target_queue_url (str): The URL of the target SQS queue.
         context_object (dict): The context object.
+        delay_seconds (int): Optional batch window for channel-queue triggers
+                             (see core/batch_window.py). Defaults to BATCH_WINDOW_SECONDS.
+                             On a FIFO queue, the length of the deduplication window.
+        window_extension_seconds (int): FIFO only - added to the trigger's batch_deadline_ms
+                             (see core/admission_controller.py). Standard queues take it
+                             as part of delay_seconds.
 
     Returns:
         str: Status code string indicating the result of the operation.
@@ -76,20 +128,29 @@ def send_message_to_queue(target_queue_url, context_object):
         return 'INTERNAL_ERROR' # Or 'BAD_INPUT'
 
     message_body = ""
+    requested_delay = delay_seconds
     delay_seconds = 0
+    fifo_params = {}
 
     if target_queue_url == HANDOFF_QUEUE_URL:
         # Send full context immediately to Handoff Queue
         try:
-            # Ensure context is JSON serializable (basic check)
-            # Remove sensitive or large fields if necessary before sending
-            # e.g., context_for_handoff = {k:v for k,v in context_object.items() if k not in ['large_field']}
-            message_body = json.dumps(context_object)
+            # Decimal values from DynamoDB are handled by the codec; large contexts are compressed or claim-checked
+            message_body = payload_codec.encode(context_object)
             delay_seconds = 0
-            logger.info(f"Sending full context for {conversation_id} to Handoff Queue: {HANDOFF_QUEUE_URL}")
+            logger.info(f"Sending full context for {conversation_id} ({len(message_body)} chars) to Handoff Queue: {HANDOFF_QUEUE_URL}")
         except TypeError as e:
             logger.error(f"Context object for {conversation_id} is not JSON serializable for Handoff Queue: {e}")
             return 'INTERNAL_ERROR' # JSON issue is likely an internal problem
+        except ClientError as e:
+            aws_error_code = e.response.get('Error', {}).get('Code')
+            logger.error(f"Payload store ClientError for {conversation_id}: {aws_error_code} - {e}")
+            if retry_policy.is_retryable(aws_error_code):
+                return 'PAYLOAD_STORE_TRANSIENT_ERROR'
+            return 'PAYLOAD_STORE_ERROR'
+        except OSError as e:
+            logger.error(f"Payload store write failed for {conversation_id}: {e}")
+            return 'PAYLOAD_STORE_ERROR'
     else:
         # Send minimal trigger message with delay to Channel Queue
         primary_channel = None
@@ -117,15 +178,30 @@ def send_message_to_queue(target_queue_url, context_object):
             "conversation_id": conversation_id,
             "primary_channel": primary_channel
         }
+        delay_seconds = BATCH_WINDOW_SECONDS if requested_delay is None else int(requested_delay)
+        delay_seconds = max(0, min(SQS_MAX_DELAY_SECONDS, delay_seconds))
+        if is_fifo_queue(target_queue_url):
+            window_index, deadline_ms = fifo_trigger_window(delay_seconds)
+            deadline_ms += max(0, int(window_extension_seconds or 0)) * 1000
+            message_body_dict['batch_deadline_ms'] = deadline_ms
+            fifo_params = {
+                'MessageGroupId': _fifo_id(conversation_id),
+                'MessageDeduplicationId': _fifo_id(f"{conversation_id}:{window_index}")
+            }
+            logger.info(f"Sending trigger for {conversation_id}/{primary_channel} to FIFO Channel Queue: {target_queue_url} for window {window_index} (deadline {deadline_ms})")
+        else:
+            logger.info(f"Sending trigger for {conversation_id}/{primary_channel} to Channel Queue: {target_queue_url} with delay {delay_seconds}s")
         message_body = json.dumps(message_body_dict)
-        delay_seconds = BATCH_WINDOW_SECONDS
-        logger.info(f"Sending trigger for {conversation_id}/{primary_channel} to Channel Queue: {target_queue_url} with delay {delay_seconds}s")
 
     try:
-        response = sqs.send_message(
+        # Consumers already tolerate SQS's at-least-once delivery, so a repeated send is safe
+        # (and on a FIFO queue it is deduplicated)
+        send_params = fifo_params or {'DelaySeconds': delay_seconds}
+        response = retry_policy.call(
+            'sqs.send_message', sqs.send_message,
             QueueUrl=target_queue_url,
             MessageBody=message_body,
-            DelaySeconds=delay_seconds
+            **send_params
         )
         logger.info(f"Successfully sent message (ID: {response.get('MessageId')}) for conversation {conversation_id} to {target_queue_url}")
         return 'SUCCESS'
@@ -144,4 +220,25 @@ def send_message_to_queue(target_queue_url, context_object):
             return 'SQS_SEND_ERROR' # Generic non-transient SQS error
     except Exception as e:
         logger.exception(f"Unexpected error sending message for {conversation_id} to {target_queue_url}")
-        return 'INTERNAL_ERROR' 
\ No newline at end of file
+        return 'INTERNAL_ERROR'
+
+
+def get_queue_depth(queue_url):
+    """
+    Returns the approximate number of messages waiting to be received from a queue
+    (ApproximateNumberOfMessages - delayed and in-flight messages are not counted),
+    or None if it could not be read.
+    """
+    try:
+        response = retry_policy.call(
+            'sqs.get_queue_attributes', sqs.get_queue_attributes,
+            QueueUrl=queue_url, AttributeNames=['ApproximateNumberOfMessages']
+        )
+        return int(response.get('Attributes', {}).get('ApproximateNumberOfMessages', 0))
+    except ClientError as e:
+        aws_error_code = e.response.get('Error', {}).get('Code')
+        logger.warning(f"SQS ClientError reading depth of {queue_url}: {aws_error_code} - {e}")
+        return None
+    except Exception as e:
+        logger.exception(f"Unexpected error reading depth of {queue_url}")
+        return None
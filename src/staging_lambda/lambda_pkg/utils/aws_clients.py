@@ -0,0 +1,124 @@
+# webhook_handler/utils/aws_clients.py
+
+"""
+The one place this Lambda builds boto3 clients and resources.
+
+Every service asks for its client here instead of calling boto3 directly:
+
+    sqs = aws_clients.client('sqs')
+    stage_table = aws_clients.resource('dynamodb').Table(STAGE_TABLE_NAME)
+
+All clients come from a single botocore session and share one Config, and each
+service gets exactly one client (and at most one resource) per container, so a
+warm container keeps its connection pools instead of building one per module.
+The DynamoDB client is a plain client, not the resource's meta.client: boto3
+registers its TypeSerializer / TypeDeserializer handlers on the resource's
+client, so wire-format calls (services/dynamodb_lowlevel.py) must not use it.
+
+The shared Config:
+
+    region              AWS_REGION, then AWS_DEFAULT_REGION, then eu-north-1
+    connection pool     AWS_MAX_POOL_CONNECTIONS (botocore's default of 10 is
+                        shared by every thread using the client)
+    timeouts            AWS_CONNECT_TIMEOUT_SECONDS / AWS_READ_TIMEOUT_SECONDS
+    TCP keepalive       AWS_TCP_KEEPALIVE, so idle pooled connections survive
+                        between invocations instead of being reset
+    retries             AWS_RETRY_MODE with AWS_RETRY_MAX_ATTEMPTS total attempts,
+                        1 by default: utils/retry_policy.py owns retries, and
+                        botocore retrying underneath it would multiply them
+    endpoints           AWS_ENDPOINT_URL_<SERVICE> or AWS_ENDPOINT_URL, to point
+                        a service at a local stand-in (DynamoDB Local, ElasticMQ)
+"""
+
+import logging
+import os
+import threading
+
+import boto3
+from botocore.config import Config
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+
+# --- Configuration ---
+AWS_REGION = os.environ.get('AWS_REGION') or os.environ.get('AWS_DEFAULT_REGION') or 'eu-north-1'
+AWS_MAX_POOL_CONNECTIONS = int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', '25'))
+AWS_CONNECT_TIMEOUT_SECONDS = float(os.environ.get('AWS_CONNECT_TIMEOUT_SECONDS', '3'))
+AWS_READ_TIMEOUT_SECONDS = float(os.environ.get('AWS_READ_TIMEOUT_SECONDS', '10'))
+AWS_TCP_KEEPALIVE = os.environ.get('AWS_TCP_KEEPALIVE', 'true').lower() == 'true'
+AWS_RETRY_MODE = os.environ.get('AWS_RETRY_MODE', 'standard')
+AWS_RETRY_MAX_ATTEMPTS = int(os.environ.get('AWS_RETRY_MAX_ATTEMPTS', '1'))
+
+# Endpoint override variables, named as botocore names them
+ENDPOINT_URL_VARIABLES = {
+    'dynamodb': 'AWS_ENDPOINT_URL_DYNAMODB',
+    'sqs': 'AWS_ENDPOINT_URL_SQS',
+    'secretsmanager': 'AWS_ENDPOINT_URL_SECRETS_MANAGER',
+}
+_session = None
+# service_name -> client / resource
+_clients = {}
+_resources = {}
+# boto3 sessions are not thread-safe when creating clients
+_lock = threading.RLock()
+
+
+def client_config():
+    """The botocore Config every client is built with."""
+    return Config(
+        region_name=AWS_REGION,
+        max_pool_connections=AWS_MAX_POOL_CONNECTIONS,
+        connect_timeout=AWS_CONNECT_TIMEOUT_SECONDS,
+        read_timeout=AWS_READ_TIMEOUT_SECONDS,
+        tcp_keepalive=AWS_TCP_KEEPALIVE,
+        retries={'mode': AWS_RETRY_MODE, 'total_max_attempts': AWS_RETRY_MAX_ATTEMPTS},
+    )
+
+
+def endpoint_url(service_name):
+    """The endpoint override for a service, or None to use the regional AWS endpoint."""
+    variable = ENDPOINT_URL_VARIABLES.get(service_name, f'AWS_ENDPOINT_URL_{service_name.upper()}')
+    return os.environ.get(variable) or os.environ.get('AWS_ENDPOINT_URL') or None
+
+
+def _get_session():
+    global _session
+    if _session is None:
+        _session = boto3.session.Session(region_name=AWS_REGION)
+    return _session
+
+
+def _build_kwargs(service_name):
+    kwargs = {'config': client_config()}
+    url = endpoint_url(service_name)
+    if url:
+        logger.info(f"Using endpoint override for {service_name}: {url}")
+        kwargs['endpoint_url'] = url
+    return kwargs
+
+
+def resource(service_name):
+    """Returns the container's boto3 resource for a service, creating it on first use."""
+    with _lock:
+        if service_name not in _resources:
+            _resources[service_name] = _get_session().resource(service_name, **_build_kwargs(service_name))
+            logger.info(f"Initialized shared {service_name} resource (pool={AWS_MAX_POOL_CONNECTIONS}, retries={AWS_RETRY_MODE})")
+        return _resources[service_name]
+
+
+def client(service_name):
+    """Returns the container's boto3 client for a service, creating it on first use."""
+    with _lock:
+        if service_name not in _clients:
+            _clients[service_name] = _get_session().client(service_name, **_build_kwargs(service_name))
+            logger.info(f"Initialized shared {service_name} client (pool={AWS_MAX_POOL_CONNECTIONS}, retries={AWS_RETRY_MODE})")
+        return _clients[service_name]
+
+
+def reset_local_state():
+    """Drops the cached session, clients and resources (tests, or after changing configuration)."""
+    global _session
+    with _lock:
+        _session = None
+        _clients.clear()
+        _resources.clear()
@@ -0,0 +1,176 @@
+# webhook_handler/utils/payload_codec.py
+
+"""
+Encoding for queue payloads that can get large - today the full context object
+sent to the human handoff queue, which carries the conversation item and its
+whole message history.
+
+    body = payload_codec.encode(context_object)         # producer (sqs_service)
+    context_object = payload_codec.decode(body)         # consumer
+
+encode() serializes with one reused, compact JSON encoder that understands the
+values the DynamoDB resource layer returns (Decimal -> int or float, set -> list,
+Binary/bytes -> base64 text), then sends the smallest form that fits:
+
+    plain JSON      below PAYLOAD_COMPRESS_THRESHOLD_BYTES, or when compressing
+                    does not help - the body is the object itself, so consumers
+                    that json.loads() the body keep working
+    compressed      {"_payload_encoding": "zlib+base64", "data": "..."} when that
+                    fits under PAYLOAD_MAX_INLINE_BYTES
+    claim check     anything still over PAYLOAD_MAX_INLINE_BYTES is written to the
+                    payload store and the body is only a pointer:
+                    {"_payload_encoding": "claim-check", "location": "s3://bucket/key",
+                     "compressed": true, "bytes": 412345, "sha256": "..."}
+
+The store is S3 (PAYLOAD_BUCKET, under PAYLOAD_KEY_PREFIX). Tests and local
+runs can set PAYLOAD_STORE_DIR to use a local directory instead. With neither
+configured there is no claim check: encode() logs an error and sends the payload
+inline, and SQS rejects it if it is over the message size limit. Objects are keyed by their SHA-256, so a retried send
+rewrites the same object instead of adding one; expiry is left to the bucket's
+lifecycle rule.
+
+Store failures raise (ClientError from S3, OSError from the directory store) so
+the caller can map them to its own status codes.
+"""
+
+import base64
+import hashlib
+import json
+import logging
+import os
+import zlib
+from decimal import Decimal
+
+from . import aws_clients, retry_policy
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+
+# --- Configuration ---
+# SQS allows 256 KiB per message, attributes included - leave headroom
+PAYLOAD_MAX_INLINE_BYTES = int(os.environ.get('PAYLOAD_MAX_INLINE_BYTES', str(240 * 1024)))
+PAYLOAD_COMPRESS_THRESHOLD_BYTES = int(os.environ.get('PAYLOAD_COMPRESS_THRESHOLD_BYTES', str(16 * 1024)))
+PAYLOAD_COMPRESSION_LEVEL = int(os.environ.get('PAYLOAD_COMPRESSION_LEVEL', '6'))
+PAYLOAD_BUCKET = os.environ.get('PAYLOAD_BUCKET')
+PAYLOAD_KEY_PREFIX = os.environ.get('PAYLOAD_KEY_PREFIX', 'handoff/')
+PAYLOAD_STORE_DIR = os.environ.get('PAYLOAD_STORE_DIR')
+
+ENCODING_KEY = '_payload_encoding'
+ENCODING_COMPRESSED = 'zlib+base64'
+ENCODING_CLAIM_CHECK = 'claim-check'
+
+
+# --- JSON ---
+
+def _json_default(value):
+    """Types json can't serialize natively, as they come out of the DynamoDB resource layer."""
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, (set, frozenset)):
+        return sorted(value, key=str)
+    if isinstance(value, (bytes, bytearray)):
+        return base64.b64encode(bytes(value)).decode('ascii')
+    raw = getattr(value, 'value', None) # boto3.dynamodb.types.Binary
+    if isinstance(raw, (bytes, bytearray)):
+        return base64.b64encode(bytes(raw)).decode('ascii')
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+# json.dumps() builds a new encoder on every call that passes options - build ours once
+_encoder = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False, default=_json_default)
+
+
+def to_json_bytes(payload):
+    """Compact UTF-8 JSON for a payload that may contain Decimal / set / Binary values."""
+    return _encoder.encode(payload).encode('utf-8')
+
+
+# --- Stores ---
+
+def _s3_location(key):
+    return f"s3://{PAYLOAD_BUCKET}/{key}"
+
+
+def _put_object(key, data):
+    """Writes data to the payload store. Returns its location."""
+    if PAYLOAD_BUCKET:
+        s3 = aws_clients.client('s3')
+        # Same key for the same bytes - repeating the write is harmless
+        retry_policy.call('s3.put_object', s3.put_object, Bucket=PAYLOAD_BUCKET, Key=key, Body=data)
+        return _s3_location(key)
+    path = os.path.join(PAYLOAD_STORE_DIR, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+    return f"file://{path}"
+
+
+def _get_object(location):
+    """Reads back an object written by _put_object."""
+    if location.startswith('s3://'):
+        bucket, _, key = location[len('s3://'):].partition('/')
+        s3 = aws_clients.client('s3')
+        response = retry_policy.call('s3.get_object', s3.get_object, Bucket=bucket, Key=key)
+        return response['Body'].read()
+    if location.startswith('file://'):
+        with open(location[len('file://'):], 'rb') as f:
+            return f.read()
+    raise ValueError(f"Unsupported payload location: {location}")
+
+
+# --- Codec ---
+
+def encode(payload):
+    """
+    Returns the message body (str) for a payload, compressed or claim-checked
+    as described above. Raises TypeError for values JSON can't represent, and
+    the store's error if a claim-check write fails.
+    """
+    data = to_json_bytes(payload)
+    if len(data) < PAYLOAD_COMPRESS_THRESHOLD_BYTES:
+        return data.decode('utf-8')
+
+    compressed = zlib.compress(data, PAYLOAD_COMPRESSION_LEVEL)
+    encoded = base64.b64encode(compressed).decode('ascii')
+    if len(encoded) < len(data) and len(encoded) + 64 <= PAYLOAD_MAX_INLINE_BYTES:
+        return json.dumps({ENCODING_KEY: ENCODING_COMPRESSED, 'data': encoded}, separators=(',', ':'))
+    if len(data) <= PAYLOAD_MAX_INLINE_BYTES:
+        return data.decode('utf-8')
+    if not PAYLOAD_BUCKET and not PAYLOAD_STORE_DIR:
+        logger.error(f"Payload of {len(data)} bytes is over PAYLOAD_MAX_INLINE_BYTES but no payload store is configured (PAYLOAD_BUCKET); sending it inline")
+        if len(encoded) < len(data):
+            return json.dumps({ENCODING_KEY: ENCODING_COMPRESSED, 'data': encoded}, separators=(',', ':'))
+        return data.decode('utf-8')
+
+    digest = hashlib.sha256(compressed).hexdigest()
+    location = _put_object(f"{PAYLOAD_KEY_PREFIX}{digest}.json.z", compressed)
+    logger.info(f"Payload of {len(data)} bytes stored at {location} (claim check)")
+    return json.dumps({
+        ENCODING_KEY: ENCODING_CLAIM_CHECK,
+        'location': location,
+        'compressed': True,
+        'bytes': len(data),
+        'sha256': digest
+    }, separators=(',', ':'))
+
+
+def decode(body):
+    """
+    The payload for a message body produced by encode() - plain, compressed or
+    claim-checked. Numbers come back as int/float. Raises ValueError if a
+    claim-checked object doesn't match its checksum.
+    """
+    message = json.loads(body)
+    encoding = message.get(ENCODING_KEY) if isinstance(message, dict) else None
+    if encoding is None:
+        return message
+    if encoding == ENCODING_COMPRESSED:
+        return json.loads(zlib.decompress(base64.b64decode(message['data'])))
+    if encoding == ENCODING_CLAIM_CHECK:
+        data = _get_object(message['location'])
+        if hashlib.sha256(data).hexdigest() != message['sha256']:
+            raise ValueError(f"Checksum mismatch for claim-checked payload at {message['location']}")
+        return json.loads(zlib.decompress(data) if message.get('compressed') else data)
+    raise ValueError(f"Unknown payload encoding: {encoding}")
@@ -96,10 +96,13 @@ def create_error_response(error_code: str, error_message: str, status_code_hint:
         'CHANNEL_NOT_ALLOWED': 403,
         'CONVERSATION_LOCKED': 409, # Conflict - locked by another process
         'VALIDATION_FAILED': 400, # Generic validation failure
+        'MESSAGE_TOO_LONG': 413,
+        'RATE_LIMITED': 429,
 
         # 5xx Server Errors
         'DB_QUERY_ERROR': 500,
         'DB_TRANSIENT_ERROR': 503,
+        'OVERLOADED': 503,
         'QUEUE_ERROR': 500,
         'INTERNAL_ERROR': 500,
         'CONFIGURATION_ERROR': 500
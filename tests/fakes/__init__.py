@@ -0,0 +1,14 @@
+"""
+Offline in-memory stand-ins for DynamoDB, SQS, Secrets Manager, OpenAI Assistants
+and Twilio, plus FakeEnvironment which points both Lambdas at them.
+See README.md in this directory.
+"""
+
+from .clock import ConcurrentVirtualClock, RealClock, VirtualClock
+from .faults import FaultInjector, client_error
+from .dynamodb import FakeDynamoDB, FakeTable
+from .sqs import FakeSQS
+from .secretsmanager import FakeSecretsManager
+from .openai_assistants import FakeOpenAIBackend, openai_error, openai_connection_error
+from .twilio_messages import FakeTwilioBackend, twilio_error
+from .environment import FakeEnvironment, twilio_signature
@@ -0,0 +1,179 @@
+"""
+Clocks for the offline stand-ins.
+
+Every fake takes a clock so delays, visibility timeouts, TTLs and simulated
+service latency can run against wall-clock time (realistic load tests) or a
+VirtualClock (fast, deterministic unit tests and simulations).
+
+A clock also acts as a drop-in for the parts of the `time` module the Lambda
+code uses (time, sleep, monotonic, perf_counter), so the harness can patch a
+module's `time` global with it.
+"""
+
+import heapq
+import threading
+import time as _time
+from contextlib import contextmanager
+
+
+class RealClock:
+    """Wall-clock time. sleep() really sleeps."""
+
+    def time(self):
+        return _time.time()
+
+    def monotonic(self):
+        return _time.monotonic()
+
+    def perf_counter(self):
+        return _time.perf_counter()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            _time.sleep(seconds)
+
+
+class VirtualClock:
+    """
+    Manually driven clock. sleep() advances time instantly instead of blocking,
+    so a 10s SQS delay or a 30s OpenAI run costs nothing in a test.
+    """
+
+    def __init__(self, start=1700000000.0):
+        self._now = float(start)
+        self._origin = float(start)
+        self._lock = threading.Lock()
+
+    def time(self):
+        with self._lock:
+            return self._now
+
+    def monotonic(self):
+        with self._lock:
+            return self._now - self._origin
+
+    perf_counter = monotonic
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def advance(self, seconds):
+        """Moves time forward (never backwards)."""
+        if seconds < 0:
+            raise ValueError("Cannot advance a clock backwards")
+        with self._lock:
+            self._now += float(seconds)
+            return self._now
+
+    def advance_to(self, timestamp):
+        """Moves time forward to an absolute epoch timestamp, if it is in the future."""
+        with self._lock:
+            if timestamp > self._now:
+                self._now = float(timestamp)
+            return self._now
+
+
+class ConcurrentVirtualClock(VirtualClock):
+    """
+    VirtualClock shared by several threads (e.g. concurrent webhook senders and
+    Lambda pollers in a load test).
+
+    Threads started with spawn() - or wrapped in participate() - take part in
+    scheduling: time only moves forward once every participating thread is
+    asleep, and then jumps straight to the earliest wake-up. Work done between
+    sleeps therefore costs no virtual time, while simulated service latency
+    (FaultInjector) and delays (SQS, batch windows, OpenAI polling) do.
+    Threads that don't participate (e.g. the SQS heartbeat thread) just wait
+    for the clock to reach their wake-up time.
+    """
+
+    def __init__(self, start=1700000000.0):
+        super().__init__(start)
+        self._lock = threading.RLock()
+        self._cond = threading.Condition(self._lock)
+        self._running = 0
+        self._sleepers = []     # heap of (wake_at, sequence, entry)
+        self._sequence = 0
+        self._local = threading.local()
+        self._threads = []
+
+    def _participating(self):
+        return getattr(self._local, 'participating', False)
+
+    def _wake_due(self):
+        while self._sleepers and self._sleepers[0][0] <= self._now:
+            _, _, entry = heapq.heappop(self._sleepers)
+            entry['awake'] = True
+            if entry['participant']:
+                self._running += 1
+        self._cond.notify_all()
+
+    def _advance_if_idle(self):
+        if self._running > 0 or not self._sleepers:
+            return
+        self._now = max(self._now, self._sleepers[0][0])
+        self._wake_due()
+
+    def sleep(self, seconds):
+        with self._cond:
+            participant = self._participating()
+            if seconds <= 0 and participant:
+                return
+            entry = {'awake': False, 'participant': participant}
+            self._sequence += 1
+            heapq.heappush(self._sleepers, (self._now + max(0.0, float(seconds)), self._sequence, entry))
+            if participant:
+                self._running -= 1
+            if seconds <= 0:
+                self._wake_due()
+            self._advance_if_idle()
+            while not entry['awake']:
+                self._cond.wait()
+
+    def advance(self, seconds):
+        if seconds < 0:
+            raise ValueError("Cannot advance a clock backwards")
+        with self._cond:
+            self._now += float(seconds)
+            self._wake_due()
+            return self._now
+
+    def advance_to(self, timestamp):
+        with self._cond:
+            if timestamp > self._now:
+                self._now = float(timestamp)
+            self._wake_due()
+            return self._now
+
+    @contextmanager
+    def participate(self):
+        """Makes the calling thread a participant for the duration of the block."""
+        with self._cond:
+            self._local.participating = True
+            self._running += 1
+        try:
+            yield self
+        finally:
+            with self._cond:
+                self._local.participating = False
+                self._running -= 1
+                self._advance_if_idle()
+
+    def spawn(self, target, *args, **kwargs):
+        """Starts `target(*args, **kwargs)` on a new participating thread and returns the thread."""
+        def run():
+            self._local.participating = True
+            try:
+                target(*args, **kwargs)
+            finally:
+                with self._cond:
+                    self._local.participating = False
+                    self._running -= 1
+                    self._advance_if_idle()
+
+        with self._cond:
+            self._running += 1   # Counted from now, so time can't move before the thread starts
+        thread = threading.Thread(target=run, daemon=True)
+        self._threads.append(thread)
+        thread.start()
+        return thread
@@ -0,0 +1,563 @@
+"""
+Parser / evaluator for the DynamoDB expression language used by the fake tables.
+
+Supports what the Lambdas (and most boto3 code) use:
+    * Condition / filter / key-condition expressions: = <> < <= > >=, BETWEEN, IN,
+      AND / OR / NOT, parentheses, attribute_exists, attribute_not_exists,
+      attribute_type, begins_with, contains, size.
+    * Update expressions: SET (with +/-, if_not_exists, list_append), REMOVE,
+      ADD (numbers and sets) and DELETE (sets).
+    * Projection expressions.
+Document paths may use #name placeholders, nested maps (a.b) and list indexes (a[0]).
+"""
+
+import copy
+import re
+from decimal import Decimal
+
+
+class ExpressionError(Exception):
+    """Invalid expression - surfaced by the fake table as a ValidationException."""
+
+
+class _Missing:
+    def __repr__(self):
+        return 'MISSING'
+
+
+MISSING = _Missing()
+
+_TOKEN_RE = re.compile(r"""
+    (?P<ws>\s+)
+  | (?P<name_ref>\#[A-Za-z0-9_]+)
+  | (?P<value_ref>:[A-Za-z0-9_]+)
+  | (?P<cmp><>|<=|>=|=|<|>)
+  | (?P<punct>[(),.\[\]+\-])
+  | (?P<number>\d+)
+  | (?P<ident>[A-Za-z_][A-Za-z0-9_]*)
+""", re.VERBOSE)
+
+_KEYWORDS = {'AND', 'OR', 'NOT', 'BETWEEN', 'IN', 'SET', 'REMOVE', 'ADD', 'DELETE'}
+_UPDATE_CLAUSES = ('SET', 'REMOVE', 'ADD', 'DELETE')
+_CONDITION_FUNCTIONS = {'attribute_exists', 'attribute_not_exists', 'attribute_type', 'begins_with', 'contains'}
+
+
+def _tokenize(expression):
+    tokens = []
+    pos = 0
+    while pos < len(expression):
+        match = _TOKEN_RE.match(expression, pos)
+        if not match:
+            raise ExpressionError(f"Invalid expression: unexpected character at {pos}: {expression[pos:pos + 10]!r}")
+        pos = match.end()
+        kind = match.lastgroup
+        text = match.group(kind)
+        if kind == 'ws':
+            continue
+        if kind == 'ident' and text.upper() in _KEYWORDS:
+            tokens.append(('kw', text.upper()))
+        else:
+            tokens.append((kind, text))
+    return tokens
+
+
+class _Parser:
+    def __init__(self, expression, names, values):
+        self.expression = expression
+        self.tokens = _tokenize(expression)
+        self.pos = 0
+        self.names = names or {}
+        self.values = values or {}
+        self.used_names = set()
+        self.used_values = set()
+
+    # --- token helpers ---
+
+    def peek(self, offset=0):
+        index = self.pos + offset
+        return self.tokens[index] if index < len(self.tokens) else (None, None)
+
+    def next(self):
+        token = self.peek()
+        if token[0] is None:
+            raise ExpressionError(f"Invalid expression: unexpected end of input: {self.expression!r}")
+        self.pos += 1
+        return token
+
+    def accept(self, kind, text=None):
+        token = self.peek()
+        if token[0] == kind and (text is None or token[1] == text):
+            self.pos += 1
+            return token
+        return None
+
+    def expect(self, kind, text=None):
+        token = self.accept(kind, text)
+        if token is None:
+            raise ExpressionError(f"Invalid expression: expected {text or kind} at token {self.peek()} in {self.expression!r}")
+        return token
+
+    def at_end(self):
+        return self.pos >= len(self.tokens)
+
+    # --- operands ---
+
+    def path(self):
+        elements = [self._path_element()]
+        while True:
+            if self.accept('punct', '.'):
+                elements.append(self._path_element())
+            elif self.accept('punct', '['):
+                index = self.expect('number')[1]
+                self.expect('punct', ']')
+                elements.append(int(index))
+            else:
+                return ('path', elements)
+
+    def _path_element(self):
+        kind, text = self.next()
+        if kind == 'name_ref':
+            if text not in self.names:
+                raise ExpressionError(f"An expression attribute name used in the document path is not defined; attribute name: {text}")
+            self.used_names.add(text)
+            return self.names[text]
+        if kind == 'ident':
+            return text
+        raise ExpressionError(f"Invalid document path element {text!r} in {self.expression!r}")
+
+    def value_ref(self):
+        text = self.expect('value_ref')[1]
+        if text not in self.values:
+            raise ExpressionError(f"An expression attribute value used in expression is not defined; attribute value: {text}")
+        self.used_values.add(text)
+        return ('value', text)
+
+    def operand(self):
+        kind, text = self.peek()
+        if kind == 'value_ref':
+            return self.value_ref()
+        if kind == 'ident' and text == 'size' and self.peek(1) == ('punct', '('):
+            self.pos += 2
+            target = self.path()
+            self.expect('punct', ')')
+            return ('size', target)
+        return self.path()
+
+    # --- conditions ---
+
+    def condition(self):
+        node = self._and()
+        while self.accept('kw', 'OR'):
+            node = ('or', node, self._and())
+        return node
+
+    def _and(self):
+        node = self._not()
+        while self.accept('kw', 'AND'):
+            node = ('and', node, self._not())
+        return node
+
+    def _not(self):
+        if self.accept('kw', 'NOT'):
+            return ('not', self._not())
+        return self._primary()
+
+    def _primary(self):
+        if self.accept('punct', '('):
+            node = self.condition()
+            self.expect('punct', ')')
+            return node
+
+        kind, text = self.peek()
+        if kind == 'ident' and text in _CONDITION_FUNCTIONS and self.peek(1) == ('punct', '('):
+            self.pos += 2
+            args = [self.path()]
+            while self.accept('punct', ','):
+                args.append(self.operand())
+            self.expect('punct', ')')
+            return ('func', text, args)
+
+        left = self.operand()
+        if self.accept('kw', 'BETWEEN'):
+            low = self.operand()
+            self.expect('kw', 'AND')
+            high = self.operand()
+            return ('between', left, low, high)
+        if self.accept('kw', 'IN'):
+            self.expect('punct', '(')
+            options = [self.operand()]
+            while self.accept('punct', ','):
+                options.append(self.operand())
+            self.expect('punct', ')')
+            return ('in', left, options)
+        op = self.expect('cmp')[1]
+        right = self.operand()
+        return ('cmp', op, left, right)
+
+    # --- update expressions ---
+
+    def update(self):
+        actions = []
+        seen = set()
+        while not self.at_end():
+            clause = self.expect('kw')[1]
+            if clause not in _UPDATE_CLAUSES:
+                raise ExpressionError(f"Invalid UpdateExpression: unexpected keyword {clause}")
+            if clause in seen:
+                raise ExpressionError(f"Invalid UpdateExpression: The \"{clause}\" section can only be used once in an update expression")
+            seen.add(clause)
+            while True:
+                target = self.path()
+                if clause == 'SET':
+                    self.expect('cmp', '=')
+                    actions.append(('SET', target, self._set_value()))
+                elif clause == 'REMOVE':
+                    actions.append(('REMOVE', target, None))
+                else:
+                    actions.append((clause, target, self.value_ref()))
+                if not self.accept('punct', ','):
+                    break
+        if not actions:
+            raise ExpressionError("Invalid UpdateExpression: The expression can not be empty")
+        return actions
+
+    def _set_value(self):
+        left = self._set_operand()
+        if self.accept('punct', '+'):
+            return ('plus', left, self._set_operand())
+        if self.accept('punct', '-'):
+            return ('minus', left, self._set_operand())
+        return left
+
+    def _set_operand(self):
+        kind, text = self.peek()
+        if kind == 'ident' and text == 'if_not_exists' and self.peek(1) == ('punct', '('):
+            self.pos += 2
+            target = self.path()
+            self.expect('punct', ',')
+            fallback = self._set_value()
+            self.expect('punct', ')')
+            return ('if_not_exists', target, fallback)
+        if kind == 'ident' and text == 'list_append' and self.peek(1) == ('punct', '('):
+            self.pos += 2
+            first = self._set_value()
+            self.expect('punct', ',')
+            second = self._set_value()
+            self.expect('punct', ')')
+            return ('list_append', first, second)
+        if kind == 'value_ref':
+            return self.value_ref()
+        return self.path()
+
+    # --- projection ---
+
+    def projection(self):
+        paths = [self.path()]
+        while self.accept('punct', ','):
+            paths.append(self.path())
+        return paths
+
+
+def _finish(parser, node):
+    if not parser.at_end():
+        raise ExpressionError(f"Invalid expression: unexpected token {parser.peek()} in {parser.expression!r}")
+    return node
+
+
+def parse_condition(expression, names=None, values=None):
+    parser = _Parser(expression, names, values)
+    return _finish(parser, parser.condition()), parser
+
+
+def parse_update(expression, names=None, values=None):
+    parser = _Parser(expression, names, values)
+    return _finish(parser, parser.update()), parser
+
+
+def parse_projection(expression, names=None):
+    parser = _Parser(expression, names, {})
+    return _finish(parser, parser.projection()), parser
+
+
+# --- Evaluation ---
+
+def resolve_path(item, elements):
+    current = item
+    for element in elements:
+        if isinstance(element, int):
+            if not isinstance(current, list) or element >= len(current):
+                return MISSING
+            current = current[element]
+        else:
+            if not isinstance(current, dict) or element not in current:
+                return MISSING
+            current = current[element]
+    return current
+
+
+def _operand_value(node, item, values):
+    kind = node[0]
+    if kind == 'value':
+        return values[node[1]]
+    if kind == 'path':
+        return resolve_path(item, node[1])
+    if kind == 'size':
+        target = resolve_path(item, node[1][1])
+        if target is MISSING or isinstance(target, (Decimal, bool)) or target is None:
+            return MISSING
+        return Decimal(len(target))
+    raise ExpressionError(f"Unsupported operand {node}")
+
+
+def _type_name(value):
+    if isinstance(value, bool):
+        return 'BOOL'
+    if value is None:
+        return 'NULL'
+    if isinstance(value, str):
+        return 'S'
+    if isinstance(value, Decimal):
+        return 'N'
+    if isinstance(value, (bytes, bytearray)):
+        return 'B'
+    if isinstance(value, dict):
+        return 'M'
+    if isinstance(value, list):
+        return 'L'
+    if isinstance(value, (set, frozenset)):
+        sample = next(iter(value), '')
+        return {'S': 'SS', 'N': 'NS', 'B': 'BS'}.get(_type_name(sample), 'SS')
+    return type(value).__name__
+
+
+def _comparable(a, b):
+    return _type_name(a) == _type_name(b) and _type_name(a) in ('S', 'N', 'B')
+
+
+def _compare(op, left, right):
+    if op == '<>':
+        if left is MISSING or right is MISSING:
+            return left is not right
+        return _type_name(left) != _type_name(right) or left != right
+    if left is MISSING or right is MISSING:
+        return False
+    if op == '=':
+        return _type_name(left) == _type_name(right) and left == right
+    if not _comparable(left, right):
+        return False
+    if op == '<':
+        return left < right
+    if op == '<=':
+        return left <= right
+    if op == '>':
+        return left > right
+    if op == '>=':
+        return left >= right
+    raise ExpressionError(f"Unsupported comparator {op}")
+
+
+def evaluate_condition(node, item, values):
+    """Evaluates a parsed condition against an item (dict). Missing item = empty dict."""
+    item = item or {}
+    kind = node[0]
+    if kind == 'or':
+        return evaluate_condition(node[1], item, values) or evaluate_condition(node[2], item, values)
+    if kind == 'and':
+        return evaluate_condition(node[1], item, values) and evaluate_condition(node[2], item, values)
+    if kind == 'not':
+        return not evaluate_condition(node[1], item, values)
+    if kind == 'cmp':
+        return _compare(node[1], _operand_value(node[2], item, values), _operand_value(node[3], item, values))
+    if kind == 'between':
+        value = _operand_value(node[1], item, values)
+        return _compare('>=', value, _operand_value(node[2], item, values)) and \
+            _compare('<=', value, _operand_value(node[3], item, values))
+    if kind == 'in':
+        value = _operand_value(node[1], item, values)
+        return any(_compare('=', value, _operand_value(option, item, values)) for option in node[2])
+    if kind == 'func':
+        name, args = node[1], node[2]
+        target = resolve_path(item, args[0][1])
+        if name == 'attribute_exists':
+            return target is not MISSING
+        if name == 'attribute_not_exists':
+            return target is MISSING
+        if target is MISSING:
+            return False
+        operand = _operand_value(args[1], item, values) if len(args) > 1 else MISSING
+        if name == 'attribute_type':
+            return _type_name(target) == operand
+        if name == 'begins_with':
+            return isinstance(target, (str, bytes)) and type(target) is type(operand) and target.startswith(operand)
+        if name == 'contains':
+            if isinstance(target, str):
+                return isinstance(operand, str) and operand in target
+            if isinstance(target, (set, frozenset, list)):
+                return operand in target
+            return False
+    raise ExpressionError(f"Unsupported condition node {node}")
+
+
+def _set_value(node, item, values):
+    kind = node[0]
+    if kind in ('value', 'path'):
+        value = _operand_value(node, item, values)
+        if value is MISSING:
+            raise ExpressionError("The provided expression refers to an attribute that does not exist in the item")
+        return copy.deepcopy(value)
+    if kind == 'if_not_exists':
+        existing = resolve_path(item, node[1][1])
+        return copy.deepcopy(existing) if existing is not MISSING else _set_value(node[2], item, values)
+    if kind == 'list_append':
+        first = _set_value(node[1], item, values)
+        second = _set_value(node[2], item, values)
+        if not isinstance(first, list) or not isinstance(second, list):
+            raise ExpressionError("An operand in the update expression has an incorrect data type")
+        return first + second
+    if kind in ('plus', 'minus'):
+        left = _set_value(node[1], item, values)
+        right = _set_value(node[2], item, values)
+        if not isinstance(left, Decimal) or not isinstance(right, Decimal) or isinstance(left, bool) or isinstance(right, bool):
+            raise ExpressionError("An operand in the update expression has an incorrect data type")
+        return left + right if kind == 'plus' else left - right
+    raise ExpressionError(f"Unsupported update value {node}")
+
+
+def _assign(item, elements, value):
+    parent = item
+    for element in elements[:-1]:
+        child = resolve_path(parent, [element])
+        if child is MISSING or not isinstance(child, (dict, list)):
+            raise ExpressionError("The document path provided in the update expression is invalid for update")
+        parent = child
+    last = elements[-1]
+    if isinstance(last, int):
+        if not isinstance(parent, list):
+            raise ExpressionError("The document path provided in the update expression is invalid for update")
+        if last >= len(parent):
+            parent.append(value)
+        else:
+            parent[last] = value
+    else:
+        if not isinstance(parent, dict):
+            raise ExpressionError("The document path provided in the update expression is invalid for update")
+        parent[last] = value
+
+
+def _remove(item, elements):
+    parent = resolve_path(item, elements[:-1]) if len(elements) > 1 else item
+    last = elements[-1]
+    if isinstance(last, int):
+        if isinstance(parent, list) and last < len(parent):
+            parent.pop(last)
+    elif isinstance(parent, dict):
+        parent.pop(last, None)
+
+
+def apply_update(actions, item, values):
+    """
+    Applies parsed update actions to a copy of `item`.
+    Right-hand sides are evaluated against the original item, as DynamoDB does.
+
+    Returns:
+        (new_item, updated_top_level_attribute_names)
+    """
+    original = item or {}
+    new_item = copy.deepcopy(original)
+    touched = set()
+    pending = []
+
+    for clause, target, operand in actions:
+        elements = target[1]
+        touched.add(elements[0])
+        if clause == 'SET':
+            pending.append(('assign', elements, _set_value(operand, original, values)))
+        elif clause == 'REMOVE':
+            pending.append(('remove', elements, None))
+        elif clause == 'ADD':
+            delta = copy.deepcopy(values[operand[1]])
+            current = resolve_path(original, elements)
+            if isinstance(delta, Decimal) and not isinstance(delta, bool):
+                if current is MISSING:
+                    current = Decimal(0)
+                if not isinstance(current, Decimal):
+                    raise ExpressionError("An operand in the update expression has an incorrect data type")
+                pending.append(('assign', elements, current + delta))
+            elif isinstance(delta, (set, frozenset)):
+                current = set() if current is MISSING else current
+                if not isinstance(current, (set, frozenset)):
+                    raise ExpressionError("An operand in the update expression has an incorrect data type")
+                pending.append(('assign', elements, set(current) | set(delta)))
+            else:
+                raise ExpressionError("Incorrect operand type for operator or function; operator: ADD")
+        elif clause == 'DELETE':
+            delta = values[operand[1]]
+            current = resolve_path(original, elements)
+            if not isinstance(delta, (set, frozenset)):
+                raise ExpressionError("Incorrect operand type for operator or function; operator: DELETE")
+            if current is MISSING:
+                continue
+            remaining = set(current) - set(delta)
+            pending.append(('assign', elements, remaining) if remaining else ('remove', elements, None))
+
+    for action, elements, value in pending:
+        if action == 'assign':
+            _assign(new_item, elements, value)
+        else:
+            _remove(new_item, elements)
+    return new_item, touched
+
+
+def _merge_projection(target, elements, value):
+    head = elements[0]
+    if len(elements) == 1:
+        if isinstance(target, list):
+            target.append(value)  # Projected list elements are compacted, as DynamoDB does
+        else:
+            target[head] = value
+        return
+    container = [] if isinstance(elements[1], int) else {}
+    if isinstance(target, list):
+        target.append(container)
+        child = container
+    else:
+        child = target.setdefault(head, container)
+    _merge_projection(child, elements[1:], value)
+
+
+def project(item, paths):
+    """Returns only the attributes named by parsed projection paths."""
+    result = {}
+    for _, elements in paths:
+        value = resolve_path(item, elements)
+        if value is not MISSING:
+            _merge_projection(result, elements, copy.deepcopy(value))
+    return result
+
+
+def key_condition_values(node, values):
+    """
+    Returns ({attribute: value} for the equality terms of a key condition, all terms),
+    validating the shape DynamoDB allows
+    (partition-key equality AND at most one sort-key condition).
+    """
+    terms = []
+
+    def collect(n):
+        if n[0] == 'and':
+            collect(n[1])
+            collect(n[2])
+        elif n[0] in ('cmp', 'between') or (n[0] == 'func' and n[1] == 'begins_with'):
+            terms.append(n)
+        else:
+            raise ExpressionError("Invalid KeyConditionExpression: only AND of key comparisons is supported")
+
+    collect(node)
+    if not terms or len(terms) > 2:
+        raise ExpressionError("Invalid KeyConditionExpression: expected one or two key conditions")
+
+    equalities = {}
+    for term in terms:
+        if term[0] == 'cmp' and term[1] == '=' and term[2][0] == 'path' and term[3][0] == 'value':
+            equalities[term[2][1][0]] = values[term[3][1]]
+    return equalities, terms
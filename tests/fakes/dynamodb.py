@@ -0,0 +1,489 @@
+"""
+In-memory stand-in for the boto3 DynamoDB *resource* API used by the Lambdas,
+plus the low-level client calls they make (aws_clients.client('dynamodb')).
+
+    ddb = FakeDynamoDB(clock, faults)
+    ddb.create_table('stage', hash_key='conversation_id', range_key='message_sid', ttl_attribute='expires_at')
+    table = ddb.Table('stage')          # same call the services make on boto3.resource('dynamodb')
+    ddb.client.get_item(TableName='stage', Key={'conversation_id': {'S': 'c1'}, ...})
+
+The client marshals with boto3's own TypeSerializer / TypeDeserializer, so it
+also checks the Lambdas' hand-written marshalling (services/dynamodb_lowlevel.py).
+
+Semantics kept from the real service:
+    * Numbers come back as Decimal; Python floats are rejected (TypeError, like boto3).
+    * ConditionExpression failures raise ClientError('ConditionalCheckFailedException').
+    * Invalid expressions / missing keys raise ClientError('ValidationException').
+    * GSIs only contain items that carry the index key attributes. Queries against a GSI
+      reject ConsistentRead=True.
+    * Query applies Limit before FilterExpression and pages with LastEvaluatedKey.
+    * TTL: items whose TTL attribute is older than now - ttl_delete_delay are dropped.
+      DynamoDB deletes lazily, so ttl_delete_delay can be raised to keep expired
+      items visible for a while.
+    * ReturnValues NONE / ALL_OLD / ALL_NEW / UPDATED_OLD / UPDATED_NEW.
+"""
+
+import copy
+import json
+import threading
+from decimal import Decimal
+
+from boto3.dynamodb.conditions import ConditionBase, ConditionExpressionBuilder
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+
+from .clock import RealClock
+from .ddb_expressions import (
+    ExpressionError, MISSING, apply_update, evaluate_condition, key_condition_values,
+    parse_condition, parse_projection, parse_update, project, resolve_path
+)
+from .faults import FaultInjector, client_error
+
+MAX_ITEM_SIZE_BYTES = 400 * 1024
+
+
+def to_dynamo(value):
+    """Normalises Python values the way boto3's TypeSerializer would accept them."""
+    if isinstance(value, bool) or value is None or isinstance(value, (str, bytes, Decimal)):
+        return value
+    if isinstance(value, int):
+        return Decimal(value)
+    if isinstance(value, float):
+        raise TypeError("Float types are not supported. Use Decimal types instead.")
+    if isinstance(value, dict):
+        return {k: to_dynamo(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_dynamo(v) for v in value]
+    if isinstance(value, (set, frozenset)):
+        if not value:
+            raise client_error('ValidationException', 'One or more parameter values were invalid: An number set  may not be empty')
+        return {to_dynamo(v) for v in value}
+    raise TypeError(f"Unsupported type \"{type(value)}\" for value \"{value}\"")
+
+
+def _item_size(item):
+    return len(json.dumps(item, default=str))
+
+
+class _BatchWriter:
+    """Mimics Table.batch_writer(): buffers puts/deletes and flushes in chunks of 25."""
+
+    def __init__(self, table, overwrite_by_pkeys=None):
+        self._table = table
+        self._buffer = []
+
+    def put_item(self, Item):
+        self._buffer.append(('put', Item))
+        self._maybe_flush()
+
+    def delete_item(self, Key):
+        self._buffer.append(('delete', Key))
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        if len(self._buffer) >= 25:
+            self._flush()
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        batch, self._buffer = self._buffer, []
+        self._table._faults.inject('dynamodb.batch_write_item')
+        for action, payload in batch:
+            if action == 'put':
+                self._table._put(payload)
+            else:
+                self._table._delete(payload)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self._flush()
+        return False
+
+
+class FakeTable:
+    """One table plus its GSIs. Obtained via FakeDynamoDB.Table(name)."""
+
+    def __init__(self, name, hash_key, range_key, indexes, ttl_attribute, clock, faults, ttl_delete_delay):
+        self.name = name
+        self.table_name = name
+        self.hash_key = hash_key
+        self.range_key = range_key
+        self.indexes = dict(indexes or {})   # index_name -> (hash_key, range_key or None)
+        self.ttl_attribute = ttl_attribute
+        self.ttl_delete_delay = ttl_delete_delay
+        self._clock = clock
+        self._faults = faults
+        self._items = {}                     # primary key tuple -> item
+        self._lock = threading.RLock()
+
+    # --- helpers ---
+
+    def _key_tuple(self, key, require_exact=True):
+        if self.hash_key not in key or (self.range_key and self.range_key not in key):
+            raise client_error('ValidationException', 'The provided key element does not match the schema')
+        if require_exact and len(key) != (2 if self.range_key else 1):
+            raise client_error('ValidationException', 'The provided key element does not match the schema')
+        hash_value = to_dynamo(key[self.hash_key])
+        range_value = to_dynamo(key[self.range_key]) if self.range_key else None
+        for value in (hash_value, range_value):
+            if value is not None and (not isinstance(value, (str, bytes, Decimal)) or value == ''):
+                raise client_error('ValidationException', 'One or more parameter values are not valid. A key attribute value must be a non-empty string, number or binary')
+        return (hash_value, range_value)
+
+    def _expired(self, item):
+        if not self.ttl_attribute:
+            return False
+        ttl = item.get(self.ttl_attribute)
+        if not isinstance(ttl, Decimal):
+            return False
+        return ttl < Decimal(str(self._clock.time() - self.ttl_delete_delay))
+
+    def _get_live(self, key_tuple):
+        item = self._items.get(key_tuple)
+        if item is not None and self._expired(item):
+            del self._items[key_tuple]
+            return None
+        return item
+
+    def _live_items(self):
+        expired = [k for k, item in self._items.items() if self._expired(item)]
+        for k in expired:
+            del self._items[k]
+        return list(self._items.values())
+
+    @staticmethod
+    def _values(ExpressionAttributeValues):
+        try:
+            return {k: to_dynamo(v) for k, v in (ExpressionAttributeValues or {}).items()}
+        except TypeError:
+            raise
+
+    def _condition(self, expression, names, values):
+        if expression is None:
+            return None
+        if isinstance(expression, ConditionBase):
+            built = ConditionExpressionBuilder().build_expression(expression)
+            names = dict(names or {}, **built.attribute_name_placeholders)
+            values = dict(values or {}, **{k: to_dynamo(v) for k, v in built.attribute_value_placeholders.items()})
+            expression = built.condition_expression
+        node, _ = parse_condition(expression, names, values)
+        return node, values
+
+    def _check(self, ConditionExpression, names, values, current):
+        parsed = self._condition(ConditionExpression, names, values)
+        if parsed is None:
+            return
+        node, values = parsed
+        if not evaluate_condition(node, current or {}, values):
+            raise client_error('ConditionalCheckFailedException', 'The conditional request failed')
+
+    @staticmethod
+    def _return(ReturnValues, old, new, touched):
+        mode = ReturnValues or 'NONE'
+        if mode == 'NONE':
+            return {}
+        if mode == 'ALL_OLD':
+            return {'Attributes': copy.deepcopy(old)} if old else {}
+        if mode == 'ALL_NEW':
+            return {'Attributes': copy.deepcopy(new)} if new else {}
+        if mode == 'UPDATED_OLD':
+            attrs = {k: copy.deepcopy(old[k]) for k in touched if old and k in old}
+            return {'Attributes': attrs} if attrs else {}
+        if mode == 'UPDATED_NEW':
+            attrs = {k: copy.deepcopy(new[k]) for k in touched if new and k in new}
+            return {'Attributes': attrs} if attrs else {}
+        raise client_error('ValidationException', f'Invalid ReturnValues: {mode}')
+
+    def _validate_item(self, item):
+        if _item_size(item) > MAX_ITEM_SIZE_BYTES:
+            raise client_error('ValidationException', 'Item size has exceeded the maximum allowed size')
+
+    def _put(self, Item):
+        item = to_dynamo(Item)
+        key_tuple = self._key_tuple({k: item.get(k) for k in (self.hash_key, self.range_key) if k})
+        self._validate_item(item)
+        with self._lock:
+            self._items[key_tuple] = item
+
+    def _delete(self, Key):
+        key_tuple = self._key_tuple(Key)
+        with self._lock:
+            self._items.pop(key_tuple, None)
+
+    # --- boto3 Table API ---
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeNames=None,
+                 ExpressionAttributeValues=None, ReturnValues='NONE', **kwargs):
+        self._faults.inject('dynamodb.put_item')
+        try:
+            item = to_dynamo(Item)
+            values = self._values(ExpressionAttributeValues)
+            key_tuple = self._key_tuple({k: item.get(k) for k in (self.hash_key, self.range_key) if k})
+            self._validate_item(item)
+            with self._lock:
+                old = self._get_live(key_tuple)
+                self._check(ConditionExpression, ExpressionAttributeNames, values, old)
+                self._items[key_tuple] = item
+                return self._return(ReturnValues if ReturnValues in ('NONE', 'ALL_OLD') else 'NONE', old, item, set(item))
+        except ExpressionError as e:
+            raise client_error('ValidationException', str(e), 'PutItem')
+
+    def get_item(self, Key, ConsistentRead=False, ProjectionExpression=None,
+                 ExpressionAttributeNames=None, **kwargs):
+        self._faults.inject('dynamodb.get_item')
+        try:
+            key_tuple = self._key_tuple(Key)
+            with self._lock:
+                item = self._get_live(key_tuple)
+                if item is None:
+                    return {}
+                item = copy.deepcopy(item)
+            if ProjectionExpression:
+                paths, _ = parse_projection(ProjectionExpression, ExpressionAttributeNames)
+                item = project(item, paths)
+            return {'Item': item}
+        except ExpressionError as e:
+            raise client_error('ValidationException', str(e), 'GetItem')
+
+    def update_item(self, Key, UpdateExpression=None, ConditionExpression=None,
+                    ExpressionAttributeNames=None, ExpressionAttributeValues=None,
+                    ReturnValues='NONE', **kwargs):
+        self._faults.inject('dynamodb.update_item')
+        try:
+            key_tuple = self._key_tuple(Key)
+            values = self._values(ExpressionAttributeValues)
+            actions = []
+            if UpdateExpression:
+                actions, _ = parse_update(UpdateExpression, ExpressionAttributeNames, values)
+                for _, target, _ in actions:
+                    if target[1][0] in (self.hash_key, self.range_key):
+                        raise ExpressionError(f"Cannot update attribute {target[1][0]}. This attribute is part of the key")
+            with self._lock:
+                old = self._get_live(key_tuple)
+                self._check(ConditionExpression, ExpressionAttributeNames, values, old)
+                base = copy.deepcopy(old) if old else {}
+                base[self.hash_key] = key_tuple[0]
+                if self.range_key:
+                    base[self.range_key] = key_tuple[1]
+                new, touched = apply_update(actions, base, values)
+                self._validate_item(new)
+                self._items[key_tuple] = new
+                return self._return(ReturnValues, old, new, touched)
+        except ExpressionError as e:
+            raise client_error('ValidationException', str(e), 'UpdateItem')
+
+    def delete_item(self, Key, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, ReturnValues='NONE', **kwargs):
+        self._faults.inject('dynamodb.delete_item')
+        try:
+            key_tuple = self._key_tuple(Key)
+            values = self._values(ExpressionAttributeValues)
+            with self._lock:
+                old = self._get_live(key_tuple)
+                self._check(ConditionExpression, ExpressionAttributeNames, values, old)
+                self._items.pop(key_tuple, None)
+                return self._return(ReturnValues if ReturnValues in ('NONE', 'ALL_OLD') else 'NONE', old, None, set())
+        except ExpressionError as e:
+            raise client_error('ValidationException', str(e), 'DeleteItem')
+
+    def query(self, KeyConditionExpression, IndexName=None, FilterExpression=None,
+              ProjectionExpression=None, ExpressionAttributeNames=None,
+              ExpressionAttributeValues=None, Limit=None, ExclusiveStartKey=None,
+              ScanIndexForward=True, ConsistentRead=False, Select=None, **kwargs):
+        self._faults.inject('dynamodb.query')
+        try:
+            if IndexName:
+                if IndexName not in self.indexes:
+                    raise client_error('ValidationException', f'The table does not have the specified index: {IndexName}', 'Query')
+                if ConsistentRead:
+                    raise client_error('ValidationException', 'Consistent reads are not supported on global secondary indexes', 'Query')
+                hash_key, range_key = self.indexes[IndexName]
+            else:
+                hash_key, range_key = self.hash_key, self.range_key
+
+            values = self._values(ExpressionAttributeValues)
+            key_node, key_values = self._condition(KeyConditionExpression, ExpressionAttributeNames, values)
+            equalities, terms = key_condition_values(key_node, key_values)
+            if hash_key not in equalities:
+                raise ExpressionError(f"Query condition missed key schema element: {hash_key}")
+            for term in terms:
+                attribute = term[2][1][0] if term[0] == 'cmp' else term[1][1][0] if term[0] == 'between' else term[2][0][1][0]
+                if attribute not in (hash_key, range_key):
+                    raise ExpressionError(f"Query key condition not supported: {attribute} is not a key attribute")
+
+            filter_parsed = self._condition(FilterExpression, ExpressionAttributeNames, values) if FilterExpression else None
+
+            with self._lock:
+                candidates = [
+                    copy.deepcopy(item) for item in self._live_items()
+                    if item.get(hash_key) == equalities[hash_key]
+                    and (range_key is None or range_key in item)
+                    and evaluate_condition(key_node, item, key_values)
+                ]
+
+            def sort_key(item):
+                return (
+                    resolve_path(item, [range_key]) if range_key else Decimal(0),
+                    item.get(self.hash_key), item.get(self.range_key) if self.range_key else Decimal(0)
+                )
+            candidates.sort(key=sort_key, reverse=not ScanIndexForward)
+
+            if ExclusiveStartKey:
+                start = self._key_tuple({k: ExclusiveStartKey[k] for k in (self.hash_key, self.range_key) if k})
+                for i, item in enumerate(candidates):
+                    if (item.get(self.hash_key), item.get(self.range_key) if self.range_key else None) == start:
+                        candidates = candidates[i + 1:]
+                        break
+
+            response = {}
+            if Limit is not None and len(candidates) > Limit:
+                candidates = candidates[:Limit]
+                last = candidates[-1]
+                last_key = {self.hash_key: last[self.hash_key]}
+                if self.range_key:
+                    last_key[self.range_key] = last[self.range_key]
+                if IndexName:
+                    last_key[hash_key] = last[hash_key]
+                    if range_key:
+                        last_key[range_key] = last[range_key]
+                response['LastEvaluatedKey'] = last_key
+
+            scanned = len(candidates)
+            if filter_parsed:
+                node, filter_values = filter_parsed
+                candidates = [item for item in candidates if evaluate_condition(node, item, filter_values)]
+            if ProjectionExpression:
+                paths, _ = parse_projection(ProjectionExpression, ExpressionAttributeNames)
+                candidates = [project(item, paths) for item in candidates]
+
+            response.update({'Count': len(candidates), 'ScannedCount': scanned})
+            if Select != 'COUNT':
+                response['Items'] = candidates
+            return response
+        except ExpressionError as e:
+            raise client_error('ValidationException', str(e), 'Query')
+
+    def scan(self, FilterExpression=None, ProjectionExpression=None, ExpressionAttributeNames=None,
+             ExpressionAttributeValues=None, **kwargs):
+        self._faults.inject('dynamodb.scan')
+        try:
+            values = self._values(ExpressionAttributeValues)
+            with self._lock:
+                items = [copy.deepcopy(item) for item in self._live_items()]
+            scanned = len(items)
+            if FilterExpression is not None:
+                node, filter_values = self._condition(FilterExpression, ExpressionAttributeNames, values)
+                items = [item for item in items if evaluate_condition(node, item, filter_values)]
+            if ProjectionExpression:
+                paths, _ = parse_projection(ProjectionExpression, ExpressionAttributeNames)
+                items = [project(item, paths) for item in items]
+            return {'Items': items, 'Count': len(items), 'ScannedCount': scanned}
+        except ExpressionError as e:
+            raise client_error('ValidationException', str(e), 'Scan')
+
+    def batch_writer(self, overwrite_by_pkeys=None):
+        return _BatchWriter(self, overwrite_by_pkeys)
+
+    # --- test helpers (not part of boto3) ---
+
+    def all_items(self):
+        """Every live item, for assertions."""
+        with self._lock:
+            return [copy.deepcopy(item) for item in self._live_items()]
+
+    def item_count(self):
+        with self._lock:
+            return len(self._live_items())
+
+    def __repr__(self):
+        return f"FakeTable(name={self.name!r})"
+
+
+class FakeDynamoDB:
+    """Stand-in for boto3.resource('dynamodb')."""
+
+    def __init__(self, clock=None, faults=None, ttl_delete_delay=0.0):
+        self.clock = clock or RealClock()
+        self.faults = faults or FaultInjector(self.clock)
+        self.ttl_delete_delay = ttl_delete_delay
+        self._tables = {}
+        self.client = FakeDynamoDBClient(self)
+
+    def create_table(self, name, hash_key, range_key=None, indexes=None, ttl_attribute=None):
+        """
+        Creates a table. `indexes` maps GSI name -> (hash_key, range_key or None).
+        Returns the FakeTable.
+        """
+        if name in self._tables:
+            raise client_error('ResourceInUseException', f'Table already exists: {name}', 'CreateTable')
+        table = FakeTable(name, hash_key, range_key, indexes, ttl_attribute,
+                          self.clock, self.faults, self.ttl_delete_delay)
+        self._tables[name] = table
+        return table
+
+    def Table(self, name):
+        if name not in self._tables:
+            # boto3 resolves tables lazily, the error surfaces on first call
+            return _MissingTable(name)
+        return self._tables[name]
+
+
+class _MissingTable:
+    """Table handle for a table that doesn't exist - every call fails like DynamoDB would."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attribute):
+        def _fail(*args, **kwargs):
+            raise client_error('ResourceNotFoundException', f'Requested resource not found: Table: {self.name} not found')
+        return _fail
+
+
+class FakeDynamoDBClient:
+    """
+    Stand-in for the low-level client (boto3.client('dynamodb')).
+    Requests are unmarshalled and run against the same FakeTables, so faults, latency
+    and conditions behave exactly as on the resource API.
+    """
+
+    def __init__(self, dynamodb):
+        self._dynamodb = dynamodb
+        self._serializer = TypeSerializer()
+        self._deserializer = TypeDeserializer()
+
+    def _from_wire(self, attribute_values):
+        return {k: self._deserializer.deserialize(v) for k, v in (attribute_values or {}).items()}
+
+    def _to_wire(self, item):
+        return {k: self._serializer.serialize(v) for k, v in item.items()}
+
+    def _call(self, operation, TableName, **request):
+        for field in ('Key', 'Item', 'ExpressionAttributeValues', 'ExclusiveStartKey'):
+            if field in request:
+                request[field] = self._from_wire(request[field])
+        response = getattr(self._dynamodb.Table(TableName), operation)(**request)
+        for field in ('Item', 'Attributes', 'LastEvaluatedKey'):
+            if field in response:
+                response[field] = self._to_wire(response[field])
+        if 'Items' in response:
+            response['Items'] = [self._to_wire(item) for item in response['Items']]
+        return response
+
+    def get_item(self, **request):
+        return self._call('get_item', **request)
+
+    def put_item(self, **request):
+        return self._call('put_item', **request)
+
+    def update_item(self, **request):
+        return self._call('update_item', **request)
+
+    def delete_item(self, **request):
+        return self._call('delete_item', **request)
+
+    def query(self, **request):
+        return self._call('query', **request)
@@ -0,0 +1,474 @@
+"""
+Wires the stand-ins into both Lambdas so the real handlers run end to end offline.
+
+    with FakeEnvironment() as env:                    # VirtualClock by default
+        conversation = env.seed_conversation()
+        env.send_webhook(conversation, 'Hi, is the role still open?')
+        env.run_until_idle()                           # waits out the batch window, runs the messaging Lambda
+        env.twilio.sent_to(conversation['whatsapp_from'])   # replies go back to the user
+
+While installed, the module-level AWS objects of both Lambdas point at the
+fakes (tables, SQS clients, Secrets Manager clients), openai.OpenAI and the
+Twilio Client are replaced by the fake backends, and the modules that read
+`time` directly use the environment clock. With a VirtualClock, batch-window
+delays, OpenAI run polling and TTLs cost no wall-clock time.
+
+Latency and errors are configured through `env.faults` (see faults.py), e.g.
+    env.faults.add_latency('dynamodb.*', 0.005)
+    env.faults.fail_next('openai.runs.create', openai_error(429))
+"""
+
+import json
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from contextlib import ExitStack
+from types import SimpleNamespace
+from unittest.mock import patch
+from urllib.parse import urlencode
+
+from twilio.request_validator import RequestValidator
+
+from .clock import VirtualClock
+from .dynamodb import FakeDynamoDB
+from .faults import FaultInjector
+from .openai_assistants import FakeOpenAIBackend
+from .secretsmanager import FakeSecretsManager
+from .sqs import FakeSQS
+from .twilio_messages import FakeTwilioBackend
+
+CONVERSATIONS_TABLE = 'conversations'
+STAGE_TABLE = 'conversations-stage'
+LOCK_TABLE = 'conversations-trigger-lock'
+COMPANY_TABLE = 'company-data'
+
+CONVERSATION_INDEXES = {
+    'company-whatsapp-number-recipient-tel-index': ('gsi_company_whatsapp_number', 'gsi_recipient_tel'),
+    'company-sms-number-recipient-tel-index': ('gsi_company_sms_number', 'gsi_recipient_tel'),
+    'company-email-recipient-email-index': ('gsi_company_email', 'gsi_recipient_email'),
+}
+
+API_HOST = 'replies.example.test'
+API_STAGE = 'dev'
+
+STAGING = 'src.staging_lambda.lambda_pkg'
+MESSAGING = 'src.messaging_lambda.whatsapp.lambda_pkg'
+
+
+def twilio_signature(auth_token, url, params):
+    """Computes X-Twilio-Signature for a form POST, exactly as Twilio signs webhooks."""
+    return RequestValidator(auth_token).compute_signature(url, params)
+
+
+class FakeEnvironment:
+    """Fake AWS / OpenAI / Twilio backends plus the patches that point both Lambdas at them."""
+
+    def __init__(self, clock=None, seed=None, openai_run_latency=1.5, heartbeat_interval_ms=300000,
+                 ttl_delete_delay=0.0, retries_enabled=True, channel_queue_type='standard',
+                 fifo_queue_delay_seconds=10):
+        """
+        ttl_delete_delay: seconds expired items stay readable. 0 enforces TTL exactly;
+        DynamoDB itself deletes expired items lazily (typically within minutes to hours).
+        retries_enabled: in-process retries of transient AWS errors (utils/retry_policy.py)
+        in both Lambdas. Off reproduces the old behaviour, where every transient error
+        fails the request.
+        channel_queue_type: 'fifo' creates the WhatsApp / SMS / email queues (and their
+        DLQs) as FIFO queues, with fifo_queue_delay_seconds as the queue's DelaySeconds -
+        the Lambdas then send and consume deduplicated triggers instead of using the
+        trigger lock. The handoff and batch request queues stay standard queues.
+        """
+        self.clock = clock or VirtualClock()
+        self.faults = FaultInjector(self.clock, seed=seed)
+
+        self.dynamodb = FakeDynamoDB(self.clock, self.faults, ttl_delete_delay=ttl_delete_delay)
+        self.conversations_table = self.dynamodb.create_table(
+            CONVERSATIONS_TABLE, 'primary_channel', 'conversation_id', CONVERSATION_INDEXES, ttl_attribute='ttl')
+        self.stage_table = self.dynamodb.create_table(
+            STAGE_TABLE, 'conversation_id', 'message_sid', ttl_attribute='expires_at')
+        self.lock_table = self.dynamodb.create_table(
+            LOCK_TABLE, 'conversation_id', ttl_attribute='expires_at')
+        self.company_table = self.dynamodb.create_table(COMPANY_TABLE, 'company_id', 'project_id')
+
+        self.sqs = FakeSQS(self.clock, self.faults)
+        self.queue_urls = {}
+        for channel in ('whatsapp', 'sms', 'email', 'handoff', 'batch'):
+            fifo = channel_queue_type == 'fifo' and channel not in ('handoff', 'batch')
+            suffix = '.fifo' if fifo else ''
+            attributes = {'FifoQueue': 'true', 'DelaySeconds': str(fifo_queue_delay_seconds)} if fifo else {}
+            dlq_url = self.sqs.create_queue(QueueName=f'{channel}-dlq{suffix}')['QueueUrl']
+            self.queue_urls[channel] = self.sqs.create_queue(QueueName=f'{channel}-queue{suffix}', Attributes=dict(attributes, **{
+                'VisibilityTimeout': '600',
+                'RedrivePolicy': json.dumps({'deadLetterTargetArn': self.sqs.queue_arn(dlq_url), 'maxReceiveCount': '3'})
+            }))['QueueUrl']
+            self.queue_urls[f'{channel}-dlq'] = dlq_url
+
+        self.secrets = FakeSecretsManager(self.clock, self.faults)
+        self.openai = FakeOpenAIBackend(self.clock, self.faults, run_latency=openai_run_latency, seed=seed)
+        self.twilio = FakeTwilioBackend(self.clock, self.faults)
+
+        self.heartbeat_interval_ms = heartbeat_interval_ms
+        self.retries_enabled = retries_enabled
+        self.staging = None
+        self.messaging = None
+        self._stack = None
+
+    # --- Installation ---
+
+    def _import_lambdas(self):
+        """Imports both Lambda packages with their client factories pointed at the fakes (first import only)."""
+        import importlib
+        factories = [importlib.import_module(f'{package}.utils.aws_clients') for package in (STAGING, MESSAGING)]
+
+        environ = {
+            'AWS_DEFAULT_REGION': os.environ.get('AWS_DEFAULT_REGION', 'eu-north-1'),
+            'HANDOFF_QUEUE_URL': self.queue_urls['handoff'],
+            'WHATSAPP_QUEUE_URL': self.queue_urls['whatsapp'],
+            'SMS_QUEUE_URL': self.queue_urls['sms'],
+            'EMAIL_QUEUE_URL': self.queue_urls['email'],
+            'CONVERSATIONS_TABLE': CONVERSATIONS_TABLE,
+            'CONVERSATIONS_STAGE_TABLE': STAGE_TABLE,
+            'CONVERSATIONS_TRIGGER_LOCK_TABLE': LOCK_TABLE,
+        }
+        with patch.dict(os.environ, {k: v for k, v in environ.items() if k not in os.environ}), ExitStack() as stack:
+            for factory in factories:
+                stack.enter_context(patch.object(factory, '_clients', self._fake_clients()))
+                stack.enter_context(patch.object(factory, '_resources', self._fake_resources()))
+            staging = SimpleNamespace(
+                index=importlib.import_module(f'{STAGING}.index'),
+                aws_clients=factories[0],
+                validation=importlib.import_module(f'{STAGING}.core.validation'),
+                routing=importlib.import_module(f'{STAGING}.core.routing'),
+                rate_limiter=importlib.import_module(f'{STAGING}.core.rate_limiter'),
+                sender_filter=importlib.import_module(f'{STAGING}.core.sender_filter'),
+                keyword_rules=importlib.import_module(f'{STAGING}.core.keyword_rules'),
+                retry_policy=importlib.import_module(f'{STAGING}.utils.retry_policy'),
+                admission_controller=importlib.import_module(f'{STAGING}.core.admission_controller'),
+                dynamodb_service=importlib.import_module(f'{STAGING}.services.dynamodb_service'),
+                company_config_service=importlib.import_module(f'{STAGING}.services.company_config_service'),
+                sqs_service=importlib.import_module(f'{STAGING}.services.sqs_service'),
+                secrets_manager_service=importlib.import_module(f'{STAGING}.services.secrets_manager_service'),
+            )
+            messaging = SimpleNamespace(
+                index=importlib.import_module(f'{MESSAGING}.index'),
+                aws_clients=factories[1],
+                dynamodb_service=importlib.import_module(f'{MESSAGING}.services.dynamodb_service'),
+                company_config_service=importlib.import_module(f'{MESSAGING}.services.company_config_service'),
+                secrets_manager_service=importlib.import_module(f'{MESSAGING}.services.secrets_manager_service'),
+                twilio_service=importlib.import_module(f'{MESSAGING}.services.twilio_service'),
+                sqs_service=importlib.import_module(f'{MESSAGING}.services.sqs_service'),
+                openai_service=importlib.import_module(f'{MESSAGING}.core.openai_service'),
+                reply_composer=importlib.import_module(f'{MESSAGING}.core.reply_composer'),
+                sender_rate_limiter=importlib.import_module(f'{MESSAGING}.core.sender_rate_limiter'),
+                chat_completions_service=importlib.import_module(f'{MESSAGING}.core.chat_completions_service'),
+                ai_backend=importlib.import_module(f'{MESSAGING}.core.ai_backend'),
+                key_pool=importlib.import_module(f'{MESSAGING}.core.key_pool'),
+                batch_service=importlib.import_module(f'{MESSAGING}.core.batch_service'),
+                batch_runner=importlib.import_module(f'{MESSAGING}.batch_runner'),
+                sqs_heartbeat=importlib.import_module(f'{MESSAGING}.utils.sqs_heartbeat'),
+                retry_policy=importlib.import_module(f'{MESSAGING}.utils.retry_policy'),
+                worker=importlib.import_module(f'{MESSAGING}.worker'),
+            )
+        return staging, messaging
+
+    def _fake_clients(self):
+        return {'sqs': self.sqs, 'secretsmanager': self.secrets, 'dynamodb': self.dynamodb.client}
+
+    def _fake_resources(self):
+        return {'dynamodb': self.dynamodb}
+
+    def install(self):
+        """Points both Lambdas at the fakes. Prefer using the environment as a context manager."""
+        if self._stack is not None:
+            return self
+        self.staging, self.messaging = self._import_lambdas()
+        staging, messaging = self.staging, self.messaging
+        stack = ExitStack()
+
+        def point(target, attribute, value):
+            stack.enter_context(patch.object(target, attribute, value))
+
+        stack.enter_context(patch.dict(os.environ, {
+            'WHATSAPP_QUEUE_URL': self.queue_urls['whatsapp'],
+            'CONVERSATIONS_TABLE': CONVERSATIONS_TABLE,
+            'SQS_HEARTBEAT_INTERVAL_MS': str(self.heartbeat_interval_ms),
+        }))
+
+        # Staging Lambda
+        point(staging.aws_clients, '_clients', self._fake_clients())
+        point(staging.aws_clients, '_resources', self._fake_resources())
+        point(staging.dynamodb_service, 'dynamodb_client', self.dynamodb.client)
+        point(staging.dynamodb_service, 'conversations_table', self.conversations_table)
+        point(staging.dynamodb_service, 'stage_table', self.stage_table)
+        point(staging.dynamodb_service, 'lock_table', self.lock_table)
+        point(staging.dynamodb_service, 'time', self.clock)
+        point(staging.company_config_service, 'company_data_table', self.company_table)
+        point(staging.company_config_service, 'time', self.clock)
+        point(staging.company_config_service, '_cache', {})
+        point(staging.rate_limiter, 'time', self.clock)
+        point(staging.rate_limiter, '_local_buckets', {})
+        point(staging.sender_filter, 'time', self.clock)
+        point(staging.sender_filter, '_negative_cache', OrderedDict())
+        point(staging.sender_filter, '_known_numbers', {'numbers': None, 'loaded_at': None})
+        point(staging.keyword_rules, '_compiled', {})
+        point(staging.admission_controller, 'time', self.clock)
+        point(staging.admission_controller, '_buckets', {})
+        point(staging.admission_controller, '_queue_depths', {})
+        point(staging.retry_policy, 'RETRY_ENABLED', self.retries_enabled)
+        point(staging.retry_policy, 'time', self.clock)
+        point(staging.retry_policy, '_state', threading.local())
+        point(staging.sqs_service, 'sqs', self.sqs)
+        point(staging.sqs_service, 'time', self.clock)
+        point(staging.sqs_service, 'HANDOFF_QUEUE_URL', self.queue_urls['handoff'])
+        point(staging.secrets_manager_service, 'secrets_manager', self.secrets)
+        for channel in ('whatsapp', 'sms', 'email', 'handoff'):
+            point(staging.routing, f'{channel.upper()}_QUEUE_URL', self.queue_urls[channel])
+
+        # Messaging Lambda
+        point(messaging.aws_clients, '_clients', self._fake_clients())
+        point(messaging.aws_clients, '_resources', self._fake_resources())
+        point(messaging.dynamodb_service, 'dynamodb_client', self.dynamodb.client)
+        point(messaging.dynamodb_service, 'conversations_table', self.conversations_table)
+        point(messaging.dynamodb_service, 'conversations_stage_table', self.stage_table)
+        point(messaging.dynamodb_service, 'conversations_trigger_lock_table', self.lock_table)
+        point(messaging.dynamodb_service, 'time', self.clock)
+        point(messaging.company_config_service, 'company_data_table', self.company_table)
+        point(messaging.company_config_service, 'time', self.clock)
+        point(messaging.company_config_service, '_cache', {})
+        point(messaging.secrets_manager_service, 'secrets_manager', self.secrets)
+        point(messaging.openai_service.openai, 'OpenAI', self.openai.client)
+        point(messaging.openai_service, 'time', self.clock)
+        point(messaging.chat_completions_service, 'time', self.clock)
+        point(messaging.chat_completions_service, '_assistant_cache', {})
+        point(messaging.key_pool, 'time', self.clock)
+        point(messaging.key_pool, '_keys', {})
+        point(messaging.key_pool, '_http_clients', {})
+        point(messaging.twilio_service, 'Client', self.twilio.client)
+        point(messaging.twilio_service, '_http_client', None)
+        point(messaging.sender_rate_limiter, 'time', self.clock)
+        point(messaging.sender_rate_limiter, '_local_buckets', {})
+        point(messaging.sqs_service, 'sqs', self.sqs)
+        point(messaging.index, 'time', self.clock)
+        # Batch mode is still off unless a project sets ai_config.batch_mode
+        point(messaging.index, 'BATCH_QUEUE_URL', self.queue_urls['batch'])
+        point(messaging.batch_runner, 'BATCH_QUEUE_URL', self.queue_urls['batch'])
+        point(messaging.batch_runner, 'WHATSAPP_QUEUE_URL', self.queue_urls['whatsapp'])
+        point(messaging.worker, 'time', self.clock)
+        point(messaging.retry_policy, 'RETRY_ENABLED', self.retries_enabled)
+        point(messaging.retry_policy, 'time', self.clock)
+        point(messaging.retry_policy, '_state', threading.local())
+
+        self._stack = stack
+        return self
+
+    def uninstall(self):
+        if self._stack is not None:
+            self._stack.close()
+            self._stack = None
+
+    def __enter__(self):
+        return self.install()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.uninstall()
+        return False
+
+    # --- Seeding ---
+
+    def seed_conversation(self, company_number=None, user_number=None, company_id='ci-aaa-000',
+                          project_id='pi-aaa-000', **overrides):
+        """
+        Creates an active WhatsApp conversation plus the OpenAI and Twilio secrets it references.
+        Returns a dict with the stored item and the whatsapp:-prefixed From/To a webhook would carry.
+        """
+        company_number = company_number or f"+4470{uuid.uuid4().int % 10 ** 8:08d}"
+        user_number = user_number or f"+4478{uuid.uuid4().int % 10 ** 8:08d}"
+        request_id = str(uuid.uuid4())
+        conversation_id = f"{company_id}#{project_id}#{request_id}#{company_number.lstrip('+')}"
+        account_sid = f"AC{uuid.uuid4().hex}"
+        auth_token = uuid.uuid4().hex
+        openai_secret = f"openai-api-key/{company_id}/{request_id}"
+        twilio_secret = f"whatsapp-credentials/{company_id}/{request_id}"
+
+        self.secrets.create_secret(Name=openai_secret, SecretString=json.dumps({'ai_api_key': f"sk-{uuid.uuid4().hex}"}))
+        self.secrets.create_secret(Name=twilio_secret, SecretString=json.dumps(
+            {'twilio_account_sid': account_sid, 'twilio_auth_token': auth_token}))
+        self.twilio.add_account(account_sid, auth_token)
+
+        now_iso = '2025-01-01T00:00:00+00:00'
+        item = {
+            'primary_channel': user_number,
+            'conversation_id': conversation_id,
+            'ai_config': {
+                'api_key_reference': openai_secret,
+                'assistant_id_replies': f"asst_{uuid.uuid4().hex[:24]}",
+            },
+            'allowed_channels': ['whatsapp', 'sms', 'email'],
+            'auto_queue_reply_message': False,
+            'channel_config': {
+                'company_whatsapp_number': company_number,
+                'whatsapp_credentials_id': twilio_secret,
+            },
+            'channel_method': 'whatsapp',
+            'company_id': company_id,
+            'conversation_status': 'initial_message_sent',
+            'created_at': now_iso,
+            'gsi_company_whatsapp_number': company_number,
+            'gsi_recipient_tel': user_number,
+            'hand_off_to_human': False,
+            'messages': [],
+            'project_id': project_id,
+            'project_status': 'active',
+            'recipient_tel': user_number,
+            'task_complete': 0,
+            'thread_id': f"thread_{uuid.uuid4().hex[:24]}",
+            'updated_at': now_iso,
+        }
+        item.update(overrides)
+        self.conversations_table.put_item(Item=item)
+        self.company_table.put_item(Item=self._company_record(item))
+        return {
+            'item': item,
+            'auth_token': auth_token,
+            'account_sid': account_sid,
+            'whatsapp_from': f"whatsapp:{user_number}",
+            'whatsapp_to': f"whatsapp:{company_number}",
+        }
+
+    @staticmethod
+    def _company_record(item):
+        """The company-data record a conversation item's config copy was taken from (per-channel maps nested)."""
+        record = {'company_id': item['company_id'], 'project_id': item['project_id'], 'config_version': 1}
+        for field in ('allowed_channels', 'auto_queue_reply_message', 'rate_limits', 'keyword_rules', 'company_rep', 'project_status'):
+            if field in item:
+                record[field] = item[field]
+        channel = item['channel_method']
+        record['ai_config'] = {'openai_config': {channel: item['ai_config']}}
+        record['channel_config'] = {channel: item['channel_config']}
+        return record
+
+    def update_company_config(self, company_id='ci-aaa-000', project_id='pi-aaa-000', **changes):
+        """Changes fields of a company-data record and bumps its config_version, as a config edit would."""
+        key = {'company_id': company_id, 'project_id': project_id}
+        record = self.company_table.get_item(Key=key)['Item']
+        record.update(changes)
+        record['config_version'] = record.get('config_version', 0) + 1
+        self.company_table.put_item(Item=record)
+        return record
+
+    def conversation(self, seeded):
+        """Re-reads a seeded conversation item."""
+        item = seeded['item']
+        return self.conversations_table.get_item(
+            Key={'primary_channel': item['primary_channel'], 'conversation_id': item['conversation_id']}).get('Item')
+
+    # --- Driving the Lambdas ---
+
+    def webhook_event(self, seeded, body, message_sid=None, channel='whatsapp', signed=True):
+        """Builds the API Gateway proxy event Twilio would send for an inbound message."""
+        params = {
+            'SmsMessageSid': message_sid or f"SM{uuid.uuid4().hex}",
+            'NumMedia': '0',
+            'ProfileName': 'Load Test',
+            'MessageType': 'text',
+            'Body': body,
+            'To': seeded['whatsapp_to'] if channel == 'whatsapp' else seeded['whatsapp_to'].split(':', 1)[1],
+            'From': seeded['whatsapp_from'] if channel == 'whatsapp' else seeded['whatsapp_from'].split(':', 1)[1],
+            'AccountSid': seeded['account_sid'],
+            'ApiVersion': '2010-04-01',
+        }
+        params['MessageSid'] = params['SmsMessageSid']
+        path = f'/{channel}'
+        url = f"https://{API_HOST}/{API_STAGE}{path}"
+        headers = {'Host': API_HOST, 'Content-Type': 'application/x-www-form-urlencoded'}
+        if signed:
+            headers['X-Twilio-Signature'] = twilio_signature(seeded['auth_token'], url, params)
+        return {
+            'resource': path,
+            'path': path,
+            'httpMethod': 'POST',
+            'headers': headers,
+            'requestContext': {'stage': API_STAGE, 'path': f'/{API_STAGE}{path}', 'requestId': str(uuid.uuid4())},
+            'body': urlencode(params),
+            'isBase64Encoded': False,
+        }
+
+    def send_webhook(self, seeded, body, **kwargs):
+        """Invokes the staging Lambda with a signed inbound message. Returns the handler response."""
+        return self.staging.index.handler(self.webhook_event(seeded, body, **kwargs), _LambdaContext('staging'))
+
+    def deliver(self, channel='whatsapp', max_messages=10, wait_seconds=0):
+        """
+        Receives visible messages from a channel queue and invokes the messaging Lambda
+        with them as an SQS event. Successful records are deleted (as the Lambda event source
+        mapping does with ReportBatchItemFailures); failed ones become visible again after
+        the visibility timeout. Returns the handler response, or None if nothing was visible.
+        """
+        queue_url = self.queue_urls[channel]
+        received = self.sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=max_messages,
+                                            WaitTimeSeconds=wait_seconds,
+                                            AttributeNames=['All']).get('Messages', [])
+        if not received:
+            return None
+        queue_arn = self.sqs.queue_arn(queue_url)
+        records = [{
+            'messageId': message['MessageId'],
+            'receiptHandle': message['ReceiptHandle'],
+            'body': message['Body'],
+            'attributes': message['Attributes'],
+            'messageAttributes': message.get('MessageAttributes', {}),
+            'md5OfBody': message['MD5OfBody'],
+            'eventSource': 'aws:sqs',
+            'eventSourceARN': queue_arn,
+            'awsRegion': 'eu-north-1',
+        } for message in received]
+
+        try:
+            response = self.messaging.index.handler({'Records': records}, _LambdaContext('messaging'))
+        except Exception:
+            # An unhandled error fails the whole batch
+            response = {'batchItemFailures': [{'itemIdentifier': r['messageId']} for r in records]}
+
+        failed = {f['itemIdentifier'] for f in (response or {}).get('batchItemFailures', [])}
+        for record in records:
+            if record['messageId'] not in failed:
+                self.sqs.delete_message(QueueUrl=queue_url, ReceiptHandle=record['receiptHandle'])
+        return response
+
+    def run_until_idle(self, channel='whatsapp', max_invocations=1000):
+        """
+        Delivers queued messages until the channel queue is empty. On a VirtualClock
+        the clock jumps forward to the next delayed / invisible message instead of waiting.
+        Returns the list of handler responses.
+        """
+        responses = []
+        queue_url = self.queue_urls[channel]
+        for _ in range(max_invocations):
+            response = self.deliver(channel)
+            if response is not None:
+                responses.append(response)
+                continue
+            next_visible = self.sqs.next_visible_at(queue_url)
+            if next_visible is None:
+                break
+            if isinstance(self.clock, VirtualClock):
+                self.clock.advance_to(next_visible)
+            else:
+                self.clock.sleep(max(0.0, next_visible - self.clock.time()) + 0.01)
+        return responses
+
+    def run_batches(self, event=None):
+        """Invokes the batch runner once (submit queued requests, deliver ended batches). Returns its response."""
+        return self.messaging.batch_runner.handler(event or {}, _LambdaContext('batch-runner'))
+
+
+class _LambdaContext:
+    """Minimal Lambda context object."""
+
+    def __init__(self, name):
+        self.function_name = f"fake-{name}-lambda"
+        self.aws_request_id = str(uuid.uuid4())
+        self.memory_limit_in_mb = 256
+
+    def get_remaining_time_in_millis(self):
+        return 900000
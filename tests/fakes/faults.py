@@ -0,0 +1,111 @@
+"""
+Latency and error injection shared by all stand-ins.
+
+Every fake operation calls `faults.inject('<service>.<operation>')` before doing
+its work, e.g. 'dynamodb.update_item', 'sqs.send_message', 'openai.runs.create',
+'twilio.messages.create'. Rules match exact operation names, a service prefix
+('dynamodb.*') or everything ('*'); the most specific rule wins.
+
+    faults = FaultInjector(clock, seed=1)
+    faults.add_latency('dynamodb.*', 0.004, jitter=0.002)         # 4ms +/- 2ms
+    faults.add_error('openai.runs.create', rate=0.05, error=lambda op: openai_error(429))
+    faults.fail_next('sqs.send_message', client_error('ThrottlingException'), times=2)
+"""
+
+import random
+import threading
+
+from botocore.exceptions import ClientError
+
+
+def client_error(code, message=None, operation_name='FakeOperation', http_status=400):
+    """Builds a botocore ClientError the way boto3 raises it."""
+    return ClientError(
+        error_response={
+            'Error': {'Code': code, 'Message': message or code},
+            'ResponseMetadata': {'HTTPStatusCode': http_status}
+        },
+        operation_name=operation_name
+    )
+
+
+class FaultInjector:
+    """Holds latency / error rules and applies them to fake operations."""
+
+    def __init__(self, clock, seed=None):
+        self.clock = clock
+        self._random = random.Random(seed)
+        self._latency = {}      # pattern -> (base_seconds, jitter_seconds)
+        self._errors = {}       # pattern -> (rate, error_factory)
+        self._scheduled = {}    # operation -> list of exceptions to raise next
+        self._lock = threading.Lock()
+        self.calls = {}         # operation -> call count, handy for assertions
+
+    # --- Configuration ---
+
+    def add_latency(self, pattern, seconds, jitter=0.0):
+        """Adds `seconds` (+/- uniform `jitter`) of simulated latency to matching operations."""
+        with self._lock:
+            self._latency[pattern] = (float(seconds), float(jitter))
+
+    def add_error(self, pattern, rate, error):
+        """
+        Fails matching operations with probability `rate`.
+        `error` is an exception instance or a callable(operation) -> exception.
+        """
+        if not 0.0 <= rate <= 1.0:
+            raise ValueError("rate must be between 0 and 1")
+        with self._lock:
+            self._errors[pattern] = (float(rate), error)
+
+    def fail_next(self, operation, error, times=1):
+        """Deterministically fails the next `times` calls of an exact operation."""
+        with self._lock:
+            self._scheduled.setdefault(operation, []).extend([error] * times)
+
+    def clear(self):
+        with self._lock:
+            self._latency.clear()
+            self._errors.clear()
+            self._scheduled.clear()
+
+    # --- Application ---
+
+    @staticmethod
+    def _match(rules, operation):
+        if operation in rules:
+            return rules[operation]
+        best = None
+        best_len = -1
+        for pattern, rule in rules.items():
+            if pattern.endswith('*') and operation.startswith(pattern[:-1]) and len(pattern) > best_len:
+                best, best_len = rule, len(pattern)
+        return best
+
+    @staticmethod
+    def _build(error, operation):
+        return error(operation) if callable(error) and not isinstance(error, BaseException) else error
+
+    def inject(self, operation):
+        """Applies latency, then raises a scheduled or random error if one applies."""
+        with self._lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+            latency = self._match(self._latency, operation)
+            delay = 0.0
+            if latency:
+                base, jitter = latency
+                delay = max(0.0, base + (self._random.uniform(-jitter, jitter) if jitter else 0.0))
+
+            error = None
+            scheduled = self._scheduled.get(operation)
+            if scheduled:
+                error = scheduled.pop(0)
+            else:
+                rule = self._match(self._errors, operation)
+                if rule and self._random.random() < rule[0]:
+                    error = rule[1]
+
+        if delay:
+            self.clock.sleep(delay)
+        if error is not None:
+            raise self._build(error, operation)
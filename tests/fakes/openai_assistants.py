@@ -0,0 +1,704 @@
+"""
+In-memory stand-in for the OpenAI Assistants (threads / messages / runs) API.
+
+    backend = FakeOpenAIBackend(clock, faults, run_latency=2.0)
+    client = backend.client(api_key='sk-test')      # what openai.OpenAI(api_key=...) returns
+    client.beta.threads.messages.create(thread_id='thread_1', role='user', content='hi')
+    run = client.beta.threads.runs.create(thread_id='thread_1', assistant_id='asst_1')
+    client.beta.threads.runs.retrieve(thread_id='thread_1', run_id=run.id).status   # 'in_progress'
+
+A run moves queued -> in_progress -> completed once `run_latency` (+/- jitter)
+seconds have passed on the clock, then its assistant reply is appended to the
+thread. The reply text comes from `responder(thread_messages, assistant_id)`;
+the default echoes the last user message as the JSON the Lambdas expect
+({"content": ...}). A responder can also return a list, to have the run
+create several messages (an entry that is itself a list is one message with
+several text parts). `fail_runs` makes the next N runs end as 'failed'.
+
+runs.create(..., stream=True) returns a stream of events like the SDK's: the
+reply arrives as thread.message.delta events of `stream_chunk_chars`
+characters, spread evenly over the run latency, followed by
+thread.message.completed and thread.run.completed (or thread.run.failed).
+
+chat.completions.create takes the same `run_latency` to answer (the responder
+sees the request's messages instead of a thread, and `max_tokens` caps the
+reply), and assistants.retrieve returns the settings registered with
+`add_assistant` (or defaults).
+
+files.create / files.content and batches.create / retrieve / cancel cover the
+Batch API for /v1/chat/completions: a batch ends `batch_latency` seconds after
+it was created, and the first retrieve after that answers every request (no
+run latency or rate limit) into output / error files in OpenAI's JSONL format.
+Requests of one batch must share a model (else the batch fails validation);
+`fail_runs` turns requests into 500 error lines, and `expire_batches(n)` makes
+the next n batches end as 'expired' without results.
+
+Prompt tokens are counted as characters / 4 over what the model sees: a run's
+truncation_strategy ('last_messages') limits the thread messages, and its
+additional_instructions count too. `prompt_token_latency` adds that many
+seconds per 1000 prompt tokens to every run and completion.
+
+`set_rate_limit(requests_per_minute)` limits every API key separately: responses
+carry x-ratelimit-limit/remaining/reset-requests, and requests over the limit
+fail with 429 and retry-after. The request and response event hooks of the
+`http_client` a client is created with are called around every request, as
+httpx calls them for the real SDK.
+
+Threads are created implicitly on first use so seeded conversations can refer
+to any thread id.
+"""
+
+import itertools
+import json
+import random
+import threading
+from types import SimpleNamespace
+
+import httpx
+import openai
+
+from .clock import RealClock
+from .faults import FaultInjector
+
+TERMINAL_STATUSES = ('completed', 'failed', 'cancelled', 'expired')
+
+
+def openai_error(status_code, message=None, headers=None):
+    """Builds the openai exception the SDK raises for an HTTP status (429 -> RateLimitError, ...)."""
+    request = httpx.Request('POST', 'https://api.openai.com/v1/threads/runs')
+    response = httpx.Response(status_code, request=request, headers=headers)
+    classes = {
+        400: openai.BadRequestError,
+        401: openai.AuthenticationError,
+        403: openai.PermissionDeniedError,
+        404: openai.NotFoundError,
+        409: openai.ConflictError,
+        422: openai.UnprocessableEntityError,
+        429: openai.RateLimitError,
+    }
+    cls = classes.get(status_code, openai.InternalServerError if status_code >= 500 else openai.APIStatusError)
+    return cls(message or f"Simulated OpenAI error {status_code}", response=response, body=None)
+
+
+def openai_connection_error():
+    """Builds the exception the SDK raises when the API can't be reached."""
+    return openai.APIConnectionError(request=httpx.Request('POST', 'https://api.openai.com/v1/threads/runs'))
+
+
+def echo_responder(thread_messages, assistant_id):
+    """Default responder: replies with the latest user message, wrapped the way the assistants reply."""
+    last_user = next((m for m in reversed(thread_messages) if m['role'] == 'user'), None)
+    text = last_user['content'] if last_user else ''
+    return json.dumps({'content': f"Echo: {text}"})
+
+
+def _reply_messages(reply):
+    """A responder's reply as a list of messages, each a list of text parts.
+
+    A string is one single-part message; a list holds one entry per message,
+    where an entry is a string or a list of text parts.
+    """
+    if isinstance(reply, str):
+        return [[reply]]
+    return [[entry] if isinstance(entry, str) else list(entry) for entry in reply]
+
+
+def _reply_text(reply):
+    return ''.join(''.join(parts) for parts in _reply_messages(reply))
+
+
+def _message_object(message):
+    return SimpleNamespace(
+        id=message['id'],
+        object='thread.message',
+        thread_id=message['thread_id'],
+        role=message['role'],
+        run_id=message['run_id'],
+        assistant_id=message['assistant_id'],
+        created_at=message['created_at'],
+        content=[SimpleNamespace(type='text', text=SimpleNamespace(value=part, annotations=[]))
+                 for part in message.get('parts') or [message['content']]],
+    )
+
+
+def _run_object(run):
+    usage = None
+    if run['status'] == 'completed':
+        usage = SimpleNamespace(prompt_tokens=run['prompt_tokens'], completion_tokens=run['completion_tokens'],
+                                total_tokens=run['prompt_tokens'] + run['completion_tokens'])
+    last_error = SimpleNamespace(code='server_error', message='Simulated run failure') if run['status'] == 'failed' else None
+    return SimpleNamespace(
+        id=run['id'],
+        object='thread.run',
+        thread_id=run['thread_id'],
+        assistant_id=run['assistant_id'],
+        status=run['status'],
+        created_at=run['created_at'],
+        completed_at=run.get('completed_at'),
+        last_error=last_error,
+        required_action=None,
+        usage=usage,
+    )
+
+
+class FakeOpenAIBackend:
+    """Shared state behind every fake client (threads, messages, runs)."""
+
+    def __init__(self, clock=None, faults=None, run_latency=1.5, run_latency_jitter=0.0,
+                 responder=None, seed=None, stream_chunk_chars=12, prompt_token_latency=0.0, batch_latency=60.0):
+        self.clock = clock or RealClock()
+        self.faults = faults or FaultInjector(self.clock)
+        self.run_latency = run_latency
+        self.run_latency_jitter = run_latency_jitter
+        # Extra seconds per 1000 prompt tokens (prompt processing time)
+        self.prompt_token_latency = prompt_token_latency
+        self.responder = responder or echo_responder
+        self.stream_chunk_chars = stream_chunk_chars
+        self._random = random.Random(seed)
+        self._threads = {}          # thread_id -> [message dicts], oldest first
+        self._runs = {}             # run_id -> run dict
+        self._ids = itertools.count(1)
+        self._lock = threading.RLock()
+        self._runs_to_fail = 0
+        self._assistants = {}       # assistant_id -> settings
+        self.api_keys_seen = []
+        self.requests_per_minute = None
+        self._request_buckets = {}  # api_key -> {'tokens': float, 'at': timestamp}
+        self.rate_limited = 0       # requests rejected with 429
+        self.batch_latency = batch_latency
+        self._files = {}            # file_id -> bytes
+        self._batches = {}          # batch_id -> batch dict
+        self._batches_to_expire = 0
+
+    # --- configuration ---
+
+    def fail_runs(self, count=1):
+        """The next `count` runs finish with status 'failed'."""
+        with self._lock:
+            self._runs_to_fail += count
+
+    def add_assistant(self, assistant_id, instructions='You are a helpful recruiting assistant. Reply as JSON: {"content": "..."}',
+                      model='gpt-4o-mini', temperature=None, top_p=None, response_format='auto'):
+        """Registers the settings assistants.retrieve returns for assistant_id."""
+        with self._lock:
+            self._assistants[assistant_id] = dict(instructions=instructions, model=model, temperature=temperature,
+                                                  top_p=top_p, response_format=response_format)
+
+    def expire_batches(self, count=1):
+        """The next `count` batches end as 'expired' without any results."""
+        with self._lock:
+            self._batches_to_expire += count
+
+    def set_rate_limit(self, requests_per_minute):
+        """
+        Limits every API key to `requests_per_minute` (a bucket refilled evenly
+        over the minute; each key stands for its own project). Every response
+        then carries x-ratelimit-* headers, and a request over the limit fails
+        with 429 and retry-after. None removes the limit.
+        """
+        with self._lock:
+            self.requests_per_minute = requests_per_minute
+            self._request_buckets = {}
+
+    def client(self, api_key=None, http_client=None, **kwargs):
+        """Returns an object shaped like openai.OpenAI(api_key=...). http_client's response event hooks see every response."""
+        with self._lock:
+            self.api_keys_seen.append(api_key)
+        hooks = getattr(http_client, 'event_hooks', None) or {}
+        return FakeOpenAIClient(self, api_key, hooks.get('request', []), hooks.get('response', []))
+
+    # --- internals ---
+
+    def _id(self, prefix):
+        return f"{prefix}_{next(self._ids):06d}"
+
+    def _thread(self, thread_id):
+        return self._threads.setdefault(thread_id, [])
+
+    def _advance(self, run):
+        """Moves a run along its lifecycle according to the clock."""
+        if run['status'] in TERMINAL_STATUSES or run['status'] == 'cancelling':
+            if run['status'] == 'cancelling':
+                run['status'] = 'cancelled'
+            return
+        now = self.clock.time()
+        if now < run['completes_at']:
+            run['status'] = 'in_progress'
+            return
+        if run['fail']:
+            run['status'] = 'failed'
+            run['failed_at'] = now
+            return
+        messages = self._thread(run['thread_id'])
+        reply = run['reply'] if 'reply' in run else self.responder(self._run_window(run), run['assistant_id'])
+        for parts in _reply_messages(reply):
+            messages.append({
+                'id': self._id('msg'), 'thread_id': run['thread_id'], 'role': 'assistant',
+                'run_id': run['id'], 'assistant_id': run['assistant_id'],
+                'created_at': int(now), 'content': ''.join(parts), 'parts': parts
+            })
+        run.update(status='completed', completed_at=int(now), completion_tokens=max(1, len(_reply_text(reply)) // 4))
+
+    def _run_window(self, run):
+        """The thread messages a run sees, after its truncation_strategy."""
+        messages = list(self._thread(run['thread_id']))
+        strategy = run.get('truncation_strategy') or {}
+        if strategy.get('type') == 'last_messages' and strategy.get('last_messages'):
+            messages = messages[-strategy['last_messages']:]
+        return messages
+
+    def _latency(self, prompt_tokens):
+        latency = self.run_latency + self.prompt_token_latency * prompt_tokens / 1000.0
+        if self.run_latency_jitter:
+            latency = max(0.0, latency + self._random.uniform(-self.run_latency_jitter, self.run_latency_jitter))
+        return latency
+
+    def _active_run(self, thread_id):
+        for run in self._runs.values():
+            if run['thread_id'] == thread_id:
+                self._advance(run)
+                if run['status'] in ('queued', 'in_progress'):
+                    return run
+        return None
+
+    def admit(self, api_key):
+        """Takes one request from the key's bucket. Returns the rate limit headers, or raises 429."""
+        with self._lock:
+            if not self.requests_per_minute:
+                return {}
+            capacity, rate = float(self.requests_per_minute), self.requests_per_minute / 60.0
+            now = self.clock.time()
+            bucket = self._request_buckets.setdefault(api_key, {'tokens': capacity, 'at': now})
+            bucket['tokens'] = min(capacity, bucket['tokens'] + (now - bucket['at']) * rate)
+            bucket['at'] = now
+            admitted = bucket['tokens'] >= 1
+            if admitted:
+                bucket['tokens'] -= 1
+            else:
+                self.rate_limited += 1
+            headers = {
+                'x-ratelimit-limit-requests': str(self.requests_per_minute),
+                'x-ratelimit-remaining-requests': str(int(bucket['tokens'])),
+                'x-ratelimit-reset-requests': f"{(capacity - bucket['tokens']) / rate:.3f}s",
+            }
+            wait = (1 - bucket['tokens']) / rate
+        if not admitted:
+            headers.update({'retry-after-ms': str(int(wait * 1000) + 1), 'retry-after': str(int(wait) + 1)})
+            raise openai_error(429, 'Rate limit reached for requests', headers=headers)
+        return headers
+
+    # --- API surface used by the fake client ---
+
+    def create_message(self, thread_id, role, content):
+        self.faults.inject('openai.messages.create')
+        with self._lock:
+            if self._active_run(thread_id):
+                raise openai_error(400, f"Can't add messages to {thread_id} while a run is active.")
+            message = {
+                'id': self._id('msg'), 'thread_id': thread_id, 'role': role, 'run_id': None,
+                'assistant_id': None, 'created_at': int(self.clock.time()),
+                'content': content if isinstance(content, str) else json.dumps(content)
+            }
+            self._thread(thread_id).append(message)
+            return _message_object(message)
+
+    def list_messages(self, thread_id, order='desc', limit=20, after=None, run_id=None):
+        self.faults.inject('openai.messages.list')
+        with self._lock:
+            messages = list(self._thread(thread_id))
+        if order == 'desc':
+            messages.reverse()
+        if run_id is not None:
+            messages = [m for m in messages if m['run_id'] == run_id]
+        if after is not None:
+            ids = [m['id'] for m in messages]
+            messages = messages[ids.index(after) + 1:] if after in ids else []
+        page = messages[:limit]
+        return SimpleNamespace(
+            data=[_message_object(m) for m in page],
+            has_more=len(messages) > limit,
+            first_id=page[0]['id'] if page else None,
+            last_id=page[-1]['id'] if page else None,
+        )
+
+    def create_run(self, thread_id, assistant_id, **kwargs):
+        self.faults.inject('openai.runs.create')
+        with self._lock:
+            active = self._active_run(thread_id)
+            if active:
+                raise openai_error(400, f"Thread {thread_id} already has an active run {active['id']}.")
+            fail = self._runs_to_fail > 0
+            if fail:
+                self._runs_to_fail -= 1
+            now = self.clock.time()
+            run = {
+                'id': self._id('run'), 'thread_id': thread_id, 'assistant_id': assistant_id,
+                'status': 'queued', 'created_at': int(now), 'fail': fail,
+                'truncation_strategy': kwargs.get('truncation_strategy'),
+            }
+            prompt_chars = sum(len(m['content']) for m in self._run_window(run))
+            prompt_chars += len(kwargs.get('additional_instructions') or '')
+            run['prompt_tokens'] = max(1, prompt_chars // 4)
+            run['completes_at'] = now + self._latency(run['prompt_tokens'])
+            self._runs[run['id']] = run
+            if kwargs.get('stream'):
+                return _Stream(self._stream_run(run))
+            return _run_object(run)
+
+    def _stream_run(self, run):
+        """Events of a streamed run, emitted as the clock reaches them."""
+        yield _event('thread.run.created', _run_object(run))
+        with self._lock:
+            if not run['fail']:
+                run['reply'] = self.responder(self._run_window(run), run['assistant_id'])
+        # (message id, block index, text) for every delta, across the reply's messages and parts
+        pieces = []
+        for parts in _reply_messages(run.get('reply', '')):
+            message_id = self._id('msg')
+            for index, part in enumerate(parts):
+                pieces.extend((message_id, index, part[i:i + self.stream_chunk_chars])
+                              for i in range(0, len(part), self.stream_chunk_chars))
+        started, span = self.clock.time(), max(0.0, run['completes_at'] - self.clock.time())
+        for n, (message_id, index, piece) in enumerate(pieces, 1):
+            self._sleep_until(started + span * n / len(pieces))
+            delta = SimpleNamespace(content=[SimpleNamespace(index=index, type='text', text=SimpleNamespace(value=piece, annotations=None))])
+            yield _event('thread.message.delta', SimpleNamespace(id=message_id, object='thread.message.delta', delta=delta))
+        self._sleep_until(run['completes_at'])
+
+        with self._lock:
+            self._advance(run)
+            run_object = _run_object(run)
+            created = [m for m in self._thread(run['thread_id']) if m['run_id'] == run['id']]
+        if run['status'] != 'completed':
+            yield _event(f"thread.run.{run['status']}", run_object)
+            return
+        for message in created:
+            yield _event('thread.message.completed', _message_object(message))
+        yield _event('thread.run.completed', run_object)
+
+    def _sleep_until(self, timestamp):
+        remaining = timestamp - self.clock.time()
+        if remaining > 0:
+            self.clock.sleep(remaining)
+
+    def retrieve_run(self, thread_id, run_id):
+        self.faults.inject('openai.runs.retrieve')
+        with self._lock:
+            run = self._runs.get(run_id)
+            if run is None or run['thread_id'] != thread_id:
+                raise openai_error(404, f"No run found with id '{run_id}'.")
+            self._advance(run)
+            return _run_object(run)
+
+    def cancel_run(self, thread_id, run_id):
+        self.faults.inject('openai.runs.cancel')
+        with self._lock:
+            run = self._runs.get(run_id)
+            if run is None or run['thread_id'] != thread_id:
+                raise openai_error(404, f"No run found with id '{run_id}'.")
+            if run['status'] in TERMINAL_STATUSES:
+                raise openai_error(400, f"Cannot cancel run with status '{run['status']}'.")
+            run['status'] = 'cancelling'
+            return _run_object(run)
+
+    def retrieve_assistant(self, assistant_id):
+        self.faults.inject('openai.assistants.retrieve')
+        with self._lock:
+            if assistant_id not in self._assistants:
+                self.add_assistant(assistant_id)
+            return SimpleNamespace(id=assistant_id, object='assistant', **self._assistants[assistant_id])
+
+    def _take_failure(self):
+        """True if the next run / completion should fail (fail_runs)."""
+        with self._lock:
+            fail = self._runs_to_fail > 0
+            if fail:
+                self._runs_to_fail -= 1
+            return fail
+
+    def _complete(self, messages, assistant_id=None, max_tokens=None):
+        """The reply text and usage of a chat completion over `messages`."""
+        prompt_tokens = max(1, sum(len(m['content']) for m in messages) // 4)
+        conversation = [{'role': m['role'], 'content': m['content']} for m in messages if m['role'] != 'system']
+        reply = _reply_text(self.responder(conversation, assistant_id))
+        if max_tokens:
+            reply = reply[:max_tokens * 4]
+        usage = SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=max(1, len(reply) // 4),
+                                total_tokens=prompt_tokens + max(1, len(reply) // 4))
+        return reply, usage
+
+    def create_chat_completion(self, model, messages, stream=False, **kwargs):
+        self.faults.inject('openai.chat.completions.create')
+        prompt_tokens = max(1, sum(len(m['content']) for m in messages) // 4)
+        with self._lock:
+            latency = self._latency(prompt_tokens)
+            completion_id = self._id('chatcmpl')
+        if self._take_failure():
+            self.clock.sleep(latency)
+            raise openai_error(500, 'Simulated completion failure')
+        reply, usage = self._complete(messages, kwargs.get('assistant_id'), kwargs.get('max_tokens'))
+        if stream:
+            return _Stream(self._stream_completion(completion_id, model, reply, latency, usage,
+                                                      (kwargs.get('stream_options') or {}).get('include_usage')))
+        self.clock.sleep(latency)
+        message = SimpleNamespace(role='assistant', content=reply)
+        return SimpleNamespace(id=completion_id, object='chat.completion', model=model, usage=usage,
+                               choices=[SimpleNamespace(index=0, message=message, finish_reason='stop')])
+
+    def _stream_completion(self, completion_id, model, reply, latency, usage, include_usage):
+        pieces = [reply[i:i + self.stream_chunk_chars] for i in range(0, len(reply), self.stream_chunk_chars)]
+        started = self.clock.time()
+        for n, piece in enumerate(pieces, 1):
+            self._sleep_until(started + latency * n / len(pieces))
+            choice = SimpleNamespace(index=0, delta=SimpleNamespace(role='assistant', content=piece), finish_reason=None)
+            yield SimpleNamespace(id=completion_id, object='chat.completion.chunk', model=model, choices=[choice], usage=None)
+        self._sleep_until(started + latency)
+        if include_usage:
+            yield SimpleNamespace(id=completion_id, object='chat.completion.chunk', model=model, choices=[], usage=usage)
+
+    def create_file(self, file, purpose):
+        self.faults.inject('openai.files.create')
+        name, content = file if isinstance(file, tuple) else (getattr(file, 'name', 'upload'), file)
+        if hasattr(content, 'read'):
+            content = content.read()
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        with self._lock:
+            file_id = self._id('file')
+            self._files[file_id] = content
+        return SimpleNamespace(id=file_id, object='file', bytes=len(content), filename=name, purpose=purpose)
+
+    def file_content(self, file_id):
+        self.faults.inject('openai.files.content')
+        with self._lock:
+            if file_id not in self._files:
+                raise openai_error(404, f"No such file: {file_id}")
+            content = self._files[file_id]
+        return SimpleNamespace(content=content, text=content.decode('utf-8'))
+
+    def create_batch(self, input_file_id, endpoint, completion_window, metadata=None):
+        self.faults.inject('openai.batches.create')
+        if endpoint != '/v1/chat/completions':
+            raise openai_error(400, f"Unsupported batch endpoint: {endpoint}")
+        with self._lock:
+            if input_file_id not in self._files:
+                raise openai_error(404, f"No such file: {input_file_id}")
+            requests = [json.loads(line) for line in self._files[input_file_id].decode('utf-8').splitlines() if line.strip()]
+            expire = self._batches_to_expire > 0
+            if expire:
+                self._batches_to_expire -= 1
+            batch = {
+                'id': self._id('batch'), 'status': 'validating', 'input_file_id': input_file_id,
+                'endpoint': endpoint, 'completion_window': completion_window, 'metadata': metadata,
+                'created_at': int(self.clock.time()), 'ends_at': self.clock.time() + self.batch_latency,
+                'requests': requests, 'expire': expire, 'output_file_id': None, 'error_file_id': None,
+                'errors': None, 'request_counts': {'total': len(requests), 'completed': 0, 'failed': 0},
+            }
+            if len({request.get('body', {}).get('model') for request in requests}) > 1:
+                batch.update(status='failed', errors={'data': [{'code': 'model_mismatch', 'message': 'Every request must use the same model.'}]})
+            self._batches[batch['id']] = batch
+            return _batch_object(batch)
+
+    def _advance_batch(self, batch):
+        """Ends a batch once batch_latency has passed, writing its output / error files."""
+        if batch['status'] in TERMINAL_STATUSES:
+            return
+        if self.clock.time() < batch['ends_at']:
+            batch['status'] = 'in_progress'
+            return
+        if batch['expire']:
+            batch['status'] = 'expired'
+            return
+        output, errors = [], []
+        for request in batch['requests']:
+            line = {'id': self._id('batch_req'), 'custom_id': request['custom_id'], 'error': None}
+            if self._take_failure():
+                line['response'] = {'status_code': 500, 'request_id': self._id('req'),
+                                    'body': {'error': {'message': 'Simulated completion failure', 'type': 'server_error'}}}
+                errors.append(line)
+                continue
+            body = request['body']
+            reply, usage = self._complete(body['messages'], max_tokens=body.get('max_tokens'))
+            line['response'] = {'status_code': 200, 'request_id': self._id('req'), 'body': {
+                'id': self._id('chatcmpl'), 'object': 'chat.completion', 'model': body['model'],
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': reply}, 'finish_reason': 'stop'}],
+                'usage': vars(usage),
+            }}
+            output.append(line)
+        for key, lines in (('output_file_id', output), ('error_file_id', errors)):
+            if lines:
+                file_id = self._id('file')
+                self._files[file_id] = ('\n'.join(json.dumps(line) for line in lines) + '\n').encode('utf-8')
+                batch[key] = file_id
+        batch['request_counts'].update(completed=len(output), failed=len(errors))
+        batch.update(status='completed', completed_at=int(self.clock.time()))
+
+    def retrieve_batch(self, batch_id):
+        self.faults.inject('openai.batches.retrieve')
+        with self._lock:
+            if batch_id not in self._batches:
+                raise openai_error(404, f"No such batch: {batch_id}")
+            batch = self._batches[batch_id]
+            self._advance_batch(batch)
+            return _batch_object(batch)
+
+    def cancel_batch(self, batch_id):
+        self.faults.inject('openai.batches.cancel')
+        with self._lock:
+            batch = self._batches[batch_id]
+            if batch['status'] not in TERMINAL_STATUSES:
+                batch['status'] = 'cancelled'
+            return _batch_object(batch)
+
+    # --- test helpers ---
+
+    def thread_messages(self, thread_id):
+        """Every message in a thread, oldest first, as plain dicts."""
+        with self._lock:
+            return [dict(m) for m in self._thread(thread_id)]
+
+    def run_count(self):
+        with self._lock:
+            return len(self._runs)
+
+    def batch_requests(self, batch_id):
+        """The requests (custom_id, body) submitted in a batch."""
+        with self._lock:
+            return [dict(request) for request in self._batches[batch_id]['requests']]
+
+    def batch_count(self):
+        with self._lock:
+            return len(self._batches)
+
+
+def _batch_object(batch):
+    return SimpleNamespace(
+        id=batch['id'], object='batch', status=batch['status'], endpoint=batch['endpoint'],
+        input_file_id=batch['input_file_id'], output_file_id=batch['output_file_id'],
+        error_file_id=batch['error_file_id'], errors=batch['errors'], completion_window=batch['completion_window'],
+        created_at=batch['created_at'], metadata=batch['metadata'],
+        request_counts=SimpleNamespace(**batch['request_counts']),
+    )
+
+
+def _event(kind, data):
+    return SimpleNamespace(event=kind, data=data)
+
+
+class _Stream:
+    """Iterable / context manager like openai.Stream."""
+
+    def __init__(self, events):
+        self._events = events
+
+    def __iter__(self):
+        return self._events
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def close(self):
+        self._events.close()
+
+
+class _Messages:
+    def __init__(self, client):
+        self._client = client
+
+    def create(self, thread_id, role, content, **kwargs):
+        return self._client._call(self._client._backend.create_message, thread_id, role, content)
+
+    def list(self, thread_id, order='desc', limit=20, after=None, run_id=None, **kwargs):
+        return self._client._call(self._client._backend.list_messages, thread_id, order=order, limit=limit,
+                                  after=after, run_id=run_id)
+
+
+class _Runs:
+    def __init__(self, client):
+        self._client = client
+
+    def create(self, thread_id, assistant_id, **kwargs):
+        return self._client._call(self._client._backend.create_run, thread_id, assistant_id, **kwargs)
+
+    def retrieve(self, run_id, thread_id, **kwargs):
+        return self._client._call(self._client._backend.retrieve_run, thread_id, run_id)
+
+    def cancel(self, run_id, thread_id, **kwargs):
+        return self._client._call(self._client._backend.cancel_run, thread_id, run_id)
+
+
+class _Assistants:
+    def __init__(self, client):
+        self._client = client
+
+    def retrieve(self, assistant_id, **kwargs):
+        return self._client._call(self._client._backend.retrieve_assistant, assistant_id)
+
+
+class _Completions:
+    def __init__(self, client):
+        self._client = client
+
+    def create(self, model, messages, **kwargs):
+        return self._client._call(self._client._backend.create_chat_completion, model, messages, **kwargs)
+
+
+class _Files:
+    def __init__(self, client):
+        self._client = client
+
+    def create(self, file, purpose, **kwargs):
+        return self._client._call(self._client._backend.create_file, file, purpose)
+
+    def content(self, file_id, **kwargs):
+        return self._client._call(self._client._backend.file_content, file_id)
+
+
+class _Batches:
+    def __init__(self, client):
+        self._client = client
+
+    def create(self, input_file_id, endpoint, completion_window, metadata=None, **kwargs):
+        return self._client._call(self._client._backend.create_batch, input_file_id, endpoint, completion_window, metadata)
+
+    def retrieve(self, batch_id, **kwargs):
+        return self._client._call(self._client._backend.retrieve_batch, batch_id)
+
+    def cancel(self, batch_id, **kwargs):
+        return self._client._call(self._client._backend.cancel_batch, batch_id)
+
+
+class FakeOpenAIClient:
+    """Mirrors the `client.beta.{assistants,threads}`, `client.chat.completions`, `client.files` and `client.batches` surface of openai.OpenAI."""
+
+    def __init__(self, backend, api_key=None, request_hooks=(), response_hooks=()):
+        self._backend = backend
+        self._api_key = api_key
+        self._request_hooks = list(request_hooks)
+        self._response_hooks = list(response_hooks)
+        threads = SimpleNamespace(messages=_Messages(self), runs=_Runs(self))
+        self.beta = SimpleNamespace(threads=threads, assistants=_Assistants(self))
+        self.chat = SimpleNamespace(completions=_Completions(self))
+        self.files = _Files(self)
+        self.batches = _Batches(self)
+
+    def _call(self, method, *args, **kwargs):
+        """One API request: request hooks, rate limit, the backend, then the response hooks (streams: once headers arrive)."""
+        for hook in self._request_hooks:
+            hook(httpx.Request('POST', 'https://api.openai.com/v1'))
+        try:
+            headers = self._backend.admit(self._api_key)
+            result = method(*args, **kwargs)
+        except openai.APIStatusError as e:
+            self._notify(e.response)
+            raise
+        self._notify(httpx.Response(200, headers=headers))
+        return result
+
+    def _notify(self, response):
+        for hook in self._response_hooks:
+            hook(response)
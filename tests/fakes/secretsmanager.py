@@ -0,0 +1,85 @@
+"""
+In-memory stand-in for the boto3 Secrets Manager *client* API.
+
+    secrets = FakeSecretsManager(clock, faults)
+    secrets.create_secret(Name='twilio/ci-aaa-000', SecretString=json.dumps({...}))
+    secrets.get_secret_value(SecretId='twilio/ci-aaa-000')
+"""
+
+import json
+import threading
+import uuid
+
+from .clock import RealClock
+from .faults import FaultInjector, client_error
+
+ACCOUNT_ID = '000000000000'
+REGION = 'eu-north-1'
+
+
+class FakeSecretsManager:
+    """Stand-in for boto3.client('secretsmanager')."""
+
+    def __init__(self, clock=None, faults=None):
+        self.clock = clock or RealClock()
+        self.faults = faults or FaultInjector(self.clock)
+        self._secrets = {}      # name -> {'arn', 'versions': [(version_id, payload)]}
+        self._lock = threading.Lock()
+
+    def _resolve(self, secret_id):
+        if secret_id in self._secrets:
+            return secret_id
+        for name, secret in self._secrets.items():
+            if secret['arn'] == secret_id:
+                return name
+        raise client_error('ResourceNotFoundException',
+                           "Secrets Manager can't find the specified secret.", 'GetSecretValue')
+
+    @staticmethod
+    def _payload(SecretString, SecretBinary):
+        if SecretString is None and SecretBinary is None:
+            raise client_error('InvalidParameterException', 'You must provide either SecretString or SecretBinary.')
+        if isinstance(SecretString, dict):
+            SecretString = json.dumps(SecretString)
+        return {'SecretString': SecretString} if SecretString is not None else {'SecretBinary': SecretBinary}
+
+    def create_secret(self, Name, SecretString=None, SecretBinary=None, **kwargs):
+        self.faults.inject('secretsmanager.create_secret')
+        payload = self._payload(SecretString, SecretBinary)
+        with self._lock:
+            if Name in self._secrets:
+                raise client_error('ResourceExistsException',
+                                   f'The operation failed because the secret {Name} already exists.', 'CreateSecret')
+            arn = f"arn:aws:secretsmanager:{REGION}:{ACCOUNT_ID}:secret:{Name}-{uuid.uuid4().hex[:6]}"
+            version_id = str(uuid.uuid4())
+            self._secrets[Name] = {'arn': arn, 'versions': [(version_id, payload, self.clock.time())]}
+        return {'ARN': arn, 'Name': Name, 'VersionId': version_id}
+
+    def put_secret_value(self, SecretId, SecretString=None, SecretBinary=None, **kwargs):
+        self.faults.inject('secretsmanager.put_secret_value')
+        payload = self._payload(SecretString, SecretBinary)
+        with self._lock:
+            name = self._resolve(SecretId)
+            version_id = str(uuid.uuid4())
+            self._secrets[name]['versions'].append((version_id, payload, self.clock.time()))
+            return {'ARN': self._secrets[name]['arn'], 'Name': name, 'VersionId': version_id}
+
+    def get_secret_value(self, SecretId, VersionId=None, **kwargs):
+        self.faults.inject('secretsmanager.get_secret_value')
+        with self._lock:
+            name = self._resolve(SecretId)
+            secret = self._secrets[name]
+            versions = secret['versions']
+            if VersionId is not None:
+                matches = [v for v in versions if v[0] == VersionId]
+                if not matches:
+                    raise client_error('ResourceNotFoundException',
+                                       "Secrets Manager can't find the specified secret value for VersionId.", 'GetSecretValue')
+                version_id, payload, created = matches[0]
+            else:
+                version_id, payload, created = versions[-1]
+            response = {'ARN': secret['arn'], 'Name': name, 'VersionId': version_id,
+                        'VersionStages': ['AWSCURRENT'] if version_id == versions[-1][0] else [],
+                        'CreatedDate': created}
+            response.update(payload)
+            return response
@@ -0,0 +1,368 @@
+"""
+In-memory stand-in for the boto3 SQS *client* API.
+
+    sqs = FakeSQS(clock, faults)
+    dlq_url = sqs.create_queue(QueueName='wa-dlq')['QueueUrl']
+    url = sqs.create_queue(QueueName='wa', Attributes={
+        'VisibilityTimeout': '600',
+        'RedrivePolicy': json.dumps({'deadLetterTargetArn': sqs.queue_arn(dlq_url), 'maxReceiveCount': '3'})
+    })['QueueUrl']
+
+Semantics kept from the real service:
+    * DelaySeconds (per message, falling back to the queue default), capped at 900s.
+    * Visibility timeouts: received messages are hidden until the timeout passes,
+      then become visible again with a new receipt handle on the next receive.
+      change_message_visibility extends / shortens it; stale receipt handles fail.
+    * Redrive: once a message has been received maxReceiveCount times, the next
+      receive moves it to the dead-letter queue instead of returning it.
+    * FIFO queues (name ends in .fifo): MessageGroupId is required and per-message
+      DelaySeconds is rejected (the queue's DelaySeconds still applies). Messages of
+      a group are handed out in send order - one receive can return several of them,
+      but none while an earlier message of the group is in flight or hidden.
+      Deduplication IDs (explicit or content-based) are remembered for 5 minutes,
+      also after the message is deleted.
+    * WaitTimeSeconds long-polls by sleeping on the clock (instant on a VirtualClock).
+"""
+
+import hashlib
+import itertools
+import json
+import threading
+import uuid
+
+from .clock import RealClock
+from .faults import FaultInjector, client_error
+
+ACCOUNT_ID = '000000000000'
+REGION = 'eu-north-1'
+MAX_DELAY_SECONDS = 900
+MAX_VISIBILITY_TIMEOUT = 43200
+FIFO_DEDUP_WINDOW_SECONDS = 300
+MAX_MESSAGE_SIZE_BYTES = 256 * 1024
+
+
+class _Message:
+    def __init__(self, body, attributes, visible_at, sent_at, group_id=None, dedup_id=None, sequence=0):
+        self.message_id = str(uuid.uuid4())
+        self.body = body
+        self.message_attributes = attributes or {}
+        self.visible_at = visible_at
+        self.sent_at = sent_at
+        self.group_id = group_id
+        self.dedup_id = dedup_id
+        self.sequence = sequence
+        self.receive_count = 0
+        self.first_received_at = None
+        self.receipt_handle = None
+
+
+class _Queue:
+    def __init__(self, name, url, attributes):
+        self.name = name
+        self.url = url
+        self.arn = f"arn:aws:sqs:{REGION}:{ACCOUNT_ID}:{name}"
+        self.fifo = name.endswith('.fifo')
+        self.visibility_timeout = int(attributes.get('VisibilityTimeout', 30))
+        self.delay_seconds = int(attributes.get('DelaySeconds', 0))
+        self.content_dedup = attributes.get('ContentBasedDeduplication', 'false').lower() == 'true'
+        redrive = attributes.get('RedrivePolicy')
+        self.redrive = json.loads(redrive) if isinstance(redrive, str) else redrive
+        self.attributes = dict(attributes)
+        self.messages = []          # in send order
+        self.dedup = {}             # dedup id -> (expires_at, message_id)
+
+
+class FakeSQS:
+    """Stand-in for boto3.client('sqs')."""
+
+    def __init__(self, clock=None, faults=None):
+        self.clock = clock or RealClock()
+        self.faults = faults or FaultInjector(self.clock)
+        self._queues = {}           # url -> _Queue
+        self._lock = threading.RLock()
+        self._sequence = itertools.count(1)
+
+    # --- helpers ---
+
+    def _queue(self, url, operation):
+        queue = self._queues.get(url)
+        if queue is None:
+            raise client_error('AWS.SimpleQueueService.NonExistentQueue',
+                               'The specified queue does not exist.', operation)
+        return queue
+
+    def queue_arn(self, url):
+        return self._queues[url].arn
+
+    def _queue_by_arn(self, arn):
+        for queue in self._queues.values():
+            if queue.arn == arn:
+                return queue
+        return None
+
+    def _enqueue(self, queue, MessageBody, DelaySeconds=None, MessageAttributes=None,
+                 MessageGroupId=None, MessageDeduplicationId=None, operation='SendMessage'):
+        if not isinstance(MessageBody, str) or not MessageBody:
+            raise client_error('InvalidParameterValue', 'The request must contain the parameter MessageBody.', operation)
+        if len(MessageBody.encode('utf-8')) > MAX_MESSAGE_SIZE_BYTES:
+            raise client_error('InvalidParameterValue', 'One or more parameters are invalid. Reason: Message must be shorter than 262144 bytes.', operation)
+        delay = queue.delay_seconds if DelaySeconds is None else DelaySeconds
+        if not isinstance(delay, int) or not 0 <= delay <= MAX_DELAY_SECONDS:
+            raise client_error('InvalidParameterValue', f'Value {delay} for parameter DelaySeconds is invalid.', operation)
+
+        now = self.clock.time()
+        if queue.fifo:
+            if not MessageGroupId:
+                raise client_error('MissingParameter', 'The request must contain the parameter MessageGroupId.', operation)
+            if DelaySeconds:
+                raise client_error('InvalidParameterValue', 'Value for parameter DelaySeconds is invalid. Reason: The request include parameter that is not valid for this queue type.', operation)
+            if not MessageDeduplicationId:
+                if not queue.content_dedup:
+                    raise client_error('InvalidParameterValue', 'The queue should either have ContentBasedDeduplication enabled or MessageDeduplicationId provided explicitly', operation)
+                MessageDeduplicationId = hashlib.sha256(MessageBody.encode('utf-8')).hexdigest()
+            queue.dedup = {k: v for k, v in queue.dedup.items() if v[0] > now}
+            if MessageDeduplicationId in queue.dedup:
+                return {'MessageId': queue.dedup[MessageDeduplicationId][1],
+                        'MD5OfMessageBody': hashlib.md5(MessageBody.encode('utf-8')).hexdigest()}
+        elif MessageGroupId:
+            raise client_error('InvalidParameterValue', 'The request include parameter that is not valid for this queue type', operation)
+
+        message = _Message(MessageBody, MessageAttributes, now + delay, now, MessageGroupId,
+                           MessageDeduplicationId, next(self._sequence))
+        queue.messages.append(message)
+        if queue.fifo:
+            queue.dedup[MessageDeduplicationId] = (now + FIFO_DEDUP_WINDOW_SECONDS, message.message_id)
+        response = {'MessageId': message.message_id,
+                    'MD5OfMessageBody': hashlib.md5(MessageBody.encode('utf-8')).hexdigest()}
+        if queue.fifo:
+            response['SequenceNumber'] = str(message.sequence)
+        return response
+
+    def _find_by_receipt(self, queue, receipt_handle):
+        for message in queue.messages:
+            if message.receipt_handle == receipt_handle:
+                return message
+        return None
+
+    # --- boto3 client API ---
+
+    def create_queue(self, QueueName, Attributes=None, **kwargs):
+        self.faults.inject('sqs.create_queue')
+        url = f"https://sqs.{REGION}.amazonaws.com/{ACCOUNT_ID}/{QueueName}"
+        with self._lock:
+            if url not in self._queues:
+                attributes = dict(Attributes or {})
+                if QueueName.endswith('.fifo'):
+                    attributes.setdefault('FifoQueue', 'true')
+                self._queues[url] = _Queue(QueueName, url, attributes)
+        return {'QueueUrl': url}
+
+    def get_queue_url(self, QueueName, **kwargs):
+        self.faults.inject('sqs.get_queue_url')
+        url = f"https://sqs.{REGION}.amazonaws.com/{ACCOUNT_ID}/{QueueName}"
+        self._queue(url, 'GetQueueUrl')
+        return {'QueueUrl': url}
+
+    def send_message(self, QueueUrl, MessageBody, DelaySeconds=None, MessageAttributes=None,
+                     MessageGroupId=None, MessageDeduplicationId=None, **kwargs):
+        self.faults.inject('sqs.send_message')
+        with self._lock:
+            queue = self._queue(QueueUrl, 'SendMessage')
+            return self._enqueue(queue, MessageBody, DelaySeconds, MessageAttributes,
+                                 MessageGroupId, MessageDeduplicationId)
+
+    def send_message_batch(self, QueueUrl, Entries, **kwargs):
+        self.faults.inject('sqs.send_message_batch')
+        if not 1 <= len(Entries) <= 10:
+            raise client_error('AWS.SimpleQueueService.TooManyEntriesInBatchRequest',
+                               'Maximum number of entries per request are 10.', 'SendMessageBatch')
+        successful, failed = [], []
+        with self._lock:
+            queue = self._queue(QueueUrl, 'SendMessageBatch')
+            for entry in Entries:
+                try:
+                    result = self._enqueue(queue, entry.get('MessageBody'), entry.get('DelaySeconds'),
+                                           entry.get('MessageAttributes'), entry.get('MessageGroupId'),
+                                           entry.get('MessageDeduplicationId'), 'SendMessageBatch')
+                    successful.append(dict(result, Id=entry['Id']))
+                except Exception as e:
+                    code = getattr(e, 'response', {}).get('Error', {}).get('Code', 'InternalError')
+                    failed.append({'Id': entry['Id'], 'SenderFault': True, 'Code': code, 'Message': str(e)})
+        response = {'Successful': successful}
+        if failed:
+            response['Failed'] = failed
+        return response
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, VisibilityTimeout=None,
+                        WaitTimeSeconds=0, AttributeNames=None, MessageAttributeNames=None,
+                        MessageSystemAttributeNames=None, **kwargs):
+        self.faults.inject('sqs.receive_message')
+        if not 1 <= MaxNumberOfMessages <= 10:
+            raise client_error('InvalidParameterValue', f'Value {MaxNumberOfMessages} for parameter MaxNumberOfMessages is invalid.', 'ReceiveMessage')
+        deadline = self.clock.time() + (WaitTimeSeconds or 0)
+        while True:
+            with self._lock:
+                queue = self._queue(QueueUrl, 'ReceiveMessage')
+                received = self._receive_now(queue, MaxNumberOfMessages, VisibilityTimeout)
+            if received or self.clock.time() >= deadline:
+                break
+            # Long poll: wait until the next message becomes visible or the wait expires
+            self.clock.sleep(max(0.0, min(deadline, self.next_visible_at(QueueUrl) or deadline) - self.clock.time()) or 0.05)
+
+        messages = []
+        for message in received:
+            entry = {
+                'MessageId': message.message_id,
+                'ReceiptHandle': message.receipt_handle,
+                'MD5OfBody': hashlib.md5(message.body.encode('utf-8')).hexdigest(),
+                'Body': message.body,
+                'Attributes': {
+                    'ApproximateReceiveCount': str(message.receive_count),
+                    'SentTimestamp': str(int(message.sent_at * 1000)),
+                    'ApproximateFirstReceiveTimestamp': str(int(message.first_received_at * 1000)),
+                    'SenderId': ACCOUNT_ID,
+                }
+            }
+            if message.group_id:
+                entry['Attributes'].update({'MessageGroupId': message.group_id,
+                                            'MessageDeduplicationId': message.dedup_id,
+                                            'SequenceNumber': str(message.sequence)})
+            if message.message_attributes:
+                entry['MessageAttributes'] = message.message_attributes
+            messages.append(entry)
+        return {'Messages': messages} if messages else {}
+
+    def _receive_now(self, queue, max_messages, visibility_timeout):
+        now = self.clock.time()
+        timeout = queue.visibility_timeout if visibility_timeout is None else visibility_timeout
+        max_receives = int(queue.redrive['maxReceiveCount']) if queue.redrive else None
+        # In-flight messages block their group for everyone else
+        blocked_groups = {m.group_id for m in queue.messages if queue.fifo and m.receipt_handle and m.visible_at > now}
+        received = []
+
+        for message in list(queue.messages):
+            if len(received) >= max_messages:
+                break
+            if queue.fifo and message.group_id in blocked_groups:
+                continue
+            if message.visible_at > now:
+                if queue.fifo:
+                    # Nothing in the group may overtake it
+                    blocked_groups.add(message.group_id)
+                continue
+            if max_receives is not None and message.receive_count >= max_receives:
+                dlq = self._queue_by_arn(queue.redrive['deadLetterTargetArn'])
+                queue.messages.remove(message)
+                if dlq is not None:
+                    message.visible_at = now
+                    message.receipt_handle = None
+                    dlq.messages.append(message)
+                continue
+            message.receive_count += 1
+            message.first_received_at = message.first_received_at or now
+            message.receipt_handle = f"{message.message_id}#{message.receive_count}#{uuid.uuid4().hex[:8]}"
+            message.visible_at = now + timeout
+            received.append(message)
+        return received
+
+    def delete_message(self, QueueUrl, ReceiptHandle, **kwargs):
+        self.faults.inject('sqs.delete_message')
+        with self._lock:
+            queue = self._queue(QueueUrl, 'DeleteMessage')
+            message = self._find_by_receipt(queue, ReceiptHandle)
+            if message is None:
+                # Deleting with a stale handle of a message that is gone is a no-op in SQS,
+                # but a handle that never existed is rejected
+                if '#' not in ReceiptHandle:
+                    raise client_error('ReceiptHandleIsInvalid', f'The input receipt handle "{ReceiptHandle}" is not a valid receipt handle.', 'DeleteMessage')
+                return {}
+            queue.messages.remove(message)
+        return {}
+
+    def delete_message_batch(self, QueueUrl, Entries, **kwargs):
+        self.faults.inject('sqs.delete_message_batch')
+        successful, failed = [], []
+        for entry in Entries:
+            try:
+                self.delete_message(QueueUrl=QueueUrl, ReceiptHandle=entry['ReceiptHandle'])
+                successful.append({'Id': entry['Id']})
+            except Exception as e:
+                code = getattr(e, 'response', {}).get('Error', {}).get('Code', 'InternalError')
+                failed.append({'Id': entry['Id'], 'SenderFault': True, 'Code': code, 'Message': str(e)})
+        response = {'Successful': successful}
+        if failed:
+            response['Failed'] = failed
+        return response
+
+    def change_message_visibility(self, QueueUrl, ReceiptHandle, VisibilityTimeout, **kwargs):
+        self.faults.inject('sqs.change_message_visibility')
+        if not 0 <= VisibilityTimeout <= MAX_VISIBILITY_TIMEOUT:
+            raise client_error('InvalidParameterValue', f'Value {VisibilityTimeout} for parameter VisibilityTimeout is invalid.', 'ChangeMessageVisibility')
+        with self._lock:
+            queue = self._queue(QueueUrl, 'ChangeMessageVisibility')
+            message = self._find_by_receipt(queue, ReceiptHandle)
+            if message is None or message.visible_at <= self.clock.time():
+                raise client_error('InvalidParameterValue',
+                                   f'Value {ReceiptHandle} for parameter ReceiptHandle is invalid. Reason: Message does not exist or is not available for visibility timeout change.',
+                                   'ChangeMessageVisibility')
+            message.visible_at = self.clock.time() + VisibilityTimeout
+        return {}
+
+    def change_message_visibility_batch(self, QueueUrl, Entries, **kwargs):
+        self.faults.inject('sqs.change_message_visibility_batch')
+        successful, failed = [], []
+        for entry in Entries:
+            try:
+                self.change_message_visibility(QueueUrl=QueueUrl, ReceiptHandle=entry['ReceiptHandle'],
+                                               VisibilityTimeout=entry['VisibilityTimeout'])
+                successful.append({'Id': entry['Id']})
+            except Exception as e:
+                code = getattr(e, 'response', {}).get('Error', {}).get('Code', 'InternalError')
+                failed.append({'Id': entry['Id'], 'SenderFault': True, 'Code': code, 'Message': str(e)})
+        response = {'Successful': successful}
+        if failed:
+            response['Failed'] = failed
+        return response
+
+    def get_queue_attributes(self, QueueUrl, AttributeNames=None, **kwargs):
+        self.faults.inject('sqs.get_queue_attributes')
+        with self._lock:
+            queue = self._queue(QueueUrl, 'GetQueueAttributes')
+            now = self.clock.time()
+            attributes = dict(queue.attributes)
+            attributes.update({
+                'QueueArn': queue.arn,
+                'VisibilityTimeout': str(queue.visibility_timeout),
+                'DelaySeconds': str(queue.delay_seconds),
+                'ApproximateNumberOfMessages': str(sum(1 for m in queue.messages if m.visible_at <= now)),
+                'ApproximateNumberOfMessagesNotVisible': str(sum(1 for m in queue.messages if m.receipt_handle and m.visible_at > now)),
+                'ApproximateNumberOfMessagesDelayed': str(sum(1 for m in queue.messages if not m.receipt_handle and m.visible_at > now)),
+            })
+        wanted = AttributeNames or ['All']
+        if 'All' not in wanted:
+            attributes = {k: v for k, v in attributes.items() if k in wanted}
+        return {'Attributes': attributes}
+
+    def purge_queue(self, QueueUrl, **kwargs):
+        self.faults.inject('sqs.purge_queue')
+        with self._lock:
+            self._queue(QueueUrl, 'PurgeQueue').messages.clear()
+        return {}
+
+    # --- test helpers (not part of boto3) ---
+
+    def next_visible_at(self, QueueUrl):
+        """Earliest time a message in the queue becomes receivable (None if empty)."""
+        with self._lock:
+            queue = self._queue(QueueUrl, 'NextVisibleAt')
+            return min((m.visible_at for m in queue.messages), default=None)
+
+    def depth(self, QueueUrl):
+        """Total messages in the queue, visible or not."""
+        with self._lock:
+            return len(self._queue(QueueUrl, 'Depth').messages)
+
+    def bodies(self, QueueUrl):
+        """Bodies of every message in the queue, in send order."""
+        with self._lock:
+            return [m.body for m in self._queue(QueueUrl, 'Bodies').messages]
@@ -0,0 +1,237 @@
+import json
+import httpx
+import pytest
+import openai
+from botocore.exceptions import ClientError
+from twilio.base.exceptions import TwilioRestException
+
+from tests.fakes import (
+    FakeOpenAIBackend, FakeSecretsManager, FakeTwilioBackend, FaultInjector, VirtualClock,
+    openai_error, twilio_error
+)
+
+# --- Fixtures ---
+
+@pytest.fixture
+def clock():
+    return VirtualClock()
+
+@pytest.fixture
+def backend(clock):
+    return FakeOpenAIBackend(clock, run_latency=3.0)
+
+def _run_to_completion(client, clock, thread_id, assistant_id='asst_1'):
+    run = client.beta.threads.runs.create(thread_id=thread_id, assistant_id=assistant_id)
+    while run.status not in ('completed', 'failed', 'cancelled', 'expired'):
+        clock.sleep(1)
+        run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
+    return run
+
+# --- Secrets Manager ---
+
+def test_secret_round_trip_and_versions(clock):
+    secrets = FakeSecretsManager(clock)
+    secrets.create_secret(Name='twilio/c1', SecretString=json.dumps({'twilio_auth_token': 'a'}))
+    secrets.put_secret_value(SecretId='twilio/c1', SecretString=json.dumps({'twilio_auth_token': 'b'}))
+    response = secrets.get_secret_value(SecretId='twilio/c1')
+    assert json.loads(response['SecretString']) == {'twilio_auth_token': 'b'}
+    assert secrets.get_secret_value(SecretId=response['ARN'])['Name'] == 'twilio/c1'
+
+def test_unknown_secret_raises_resource_not_found(clock):
+    with pytest.raises(ClientError) as excinfo:
+        FakeSecretsManager(clock).get_secret_value(SecretId='missing')
+    assert excinfo.value.response['Error']['Code'] == 'ResourceNotFoundException'
+
+# --- OpenAI Assistants ---
+
+def test_run_completes_after_latency_and_replies(backend, clock):
+    client = backend.client(api_key='sk-test')
+    client.beta.threads.messages.create(thread_id='thread_1', role='user', content='hello')
+    start = clock.time()
+    run = _run_to_completion(client, clock, 'thread_1')
+
+    assert run.status == 'completed'
+    assert clock.time() - start == pytest.approx(3.0)
+    assert run.usage.total_tokens == run.usage.prompt_tokens + run.usage.completion_tokens
+
+    latest = client.beta.threads.messages.list(thread_id='thread_1', order='desc').data[0]
+    assert latest.role == 'assistant' and latest.run_id == run.id
+    assert json.loads(latest.content[0].text.value) == {'content': 'Echo: hello'}
+    assert backend.api_keys_seen == ['sk-test']
+
+def test_custom_responder_and_run_scoped_listing(clock):
+    backend = FakeOpenAIBackend(clock, run_latency=0, responder=lambda messages, assistant_id: 'fixed')
+    client = backend.client()
+    client.beta.threads.messages.create(thread_id='t', role='user', content='q')
+    run = _run_to_completion(client, clock, 't')
+    page = client.beta.threads.messages.list(thread_id='t', run_id=run.id, limit=1)
+    assert [m.content[0].text.value for m in page.data] == ['fixed']
+    assert page.has_more is False
+
+def test_responder_can_create_several_messages_with_parts(clock):
+    backend = FakeOpenAIBackend(clock, run_latency=0, responder=lambda messages, assistant_id: ['one', ['two-a', 'two-b']])
+    client = backend.client()
+    client.beta.threads.messages.create(thread_id='t', role='user', content='q')
+    run = _run_to_completion(client, clock, 't')
+    page = client.beta.threads.messages.list(thread_id='t', run_id=run.id, order='asc')
+    assert [[block.text.value for block in m.content] for m in page.data] == [['one'], ['two-a', 'two-b']]
+
+def test_streamed_run_emits_deltas_over_the_run_latency(backend, clock):
+    client = backend.client()
+    client.beta.threads.messages.create(thread_id='thread_s', role='user', content='hello there')
+    start = clock.time()
+    events = []
+    with client.beta.threads.runs.create(thread_id='thread_s', assistant_id='asst_1', stream=True) as stream:
+        for event in stream:
+            events.append((event.event, clock.time() - start, event.data))
+
+    kinds = [kind for kind, _, _ in events]
+    assert kinds[0] == 'thread.run.created'
+    assert kinds[-2:] == ['thread.message.completed', 'thread.run.completed']
+    deltas = [(at, data.delta.content[0].text.value) for kind, at, data in events if kind == 'thread.message.delta']
+    assert ''.join(text for _, text in deltas) == json.dumps({'content': 'Echo: hello there'})
+    assert 0 < deltas[0][0] < deltas[-1][0] == pytest.approx(3.0)
+    assert events[-1][2].usage.total_tokens > 0
+    latest = client.beta.threads.messages.list(thread_id='thread_s').data[0]
+    assert latest.run_id == events[-1][2].id
+
+def test_streamed_run_failure_event(backend):
+    backend.fail_runs(1)
+    client = backend.client()
+    stream = client.beta.threads.runs.create(thread_id='thread_f', assistant_id='asst_1', stream=True)
+    assert [event.event for event in stream] == ['thread.run.created', 'thread.run.failed']
+
+def test_assistant_settings_and_chat_completion(backend, clock):
+    backend.add_assistant('asst_c', instructions='Be brief.', model='gpt-4o', temperature=0.2)
+    client = backend.client()
+    assistant = client.beta.assistants.retrieve('asst_c')
+    assert (assistant.model, assistant.instructions, assistant.temperature) == ('gpt-4o', 'Be brief.', 0.2)
+
+    start = clock.time()
+    completion = client.chat.completions.create(model='gpt-4o', messages=[
+        {'role': 'system', 'content': 'Be brief.'}, {'role': 'user', 'content': 'hello'}])
+    assert clock.time() - start == pytest.approx(3.0)
+    assert json.loads(completion.choices[0].message.content) == {'content': 'Echo: hello'}
+    assert completion.usage.prompt_tokens > 0
+
+def test_streamed_chat_completion_ends_with_usage_chunk(backend, clock):
+    client = backend.client()
+    start = clock.time()
+    chunks = list(client.chat.completions.create(model='m', messages=[{'role': 'user', 'content': 'hi'}],
+                                                 stream=True, stream_options={'include_usage': True}))
+    text = ''.join(c.choices[0].delta.content for c in chunks if c.choices)
+    assert json.loads(text) == {'content': 'Echo: hi'}
+    assert chunks[-1].choices == [] and chunks[-1].usage.total_tokens > 0
+    assert clock.time() - start == pytest.approx(3.0)
+
+def _batch_input(*requests):
+    return ''.join(json.dumps({'custom_id': custom_id, 'method': 'POST', 'url': '/v1/chat/completions',
+                               'body': {'model': model, 'messages': [{'role': 'user', 'content': text}]}}) + '\n'
+                   for custom_id, model, text in requests).encode('utf-8')
+
+def test_batch_ends_after_latency_with_output_and_error_files(clock):
+    backend = FakeOpenAIBackend(clock, batch_latency=60.0)
+    client = backend.client()
+    upload = client.files.create(file=('in.jsonl', _batch_input(('a', 'm', 'hello'), ('b', 'm', 'bye'))), purpose='batch')
+    batch = client.batches.create(input_file_id=upload.id, endpoint='/v1/chat/completions', completion_window='24h')
+    assert client.batches.retrieve(batch.id).status == 'in_progress'
+
+    backend.fail_runs(1)
+    clock.advance(60)
+    ended_at = clock.time()
+    batch = client.batches.retrieve(batch.id)
+    assert clock.time() == ended_at                 # no run latency for batched requests
+    assert batch.status == 'completed' and (batch.request_counts.completed, batch.request_counts.failed) == (1, 1)
+    output = [json.loads(line) for line in client.files.content(batch.output_file_id).text.splitlines()]
+    errors = [json.loads(line) for line in client.files.content(batch.error_file_id).text.splitlines()]
+    assert output[0]['custom_id'] == 'b' and output[0]['response']['status_code'] == 200
+    assert json.loads(output[0]['response']['body']['choices'][0]['message']['content']) == {'content': 'Echo: bye'}
+    assert errors[0]['custom_id'] == 'a' and errors[0]['response']['status_code'] == 500
+
+def test_batch_validation_and_expiry(clock):
+    backend = FakeOpenAIBackend(clock, batch_latency=60.0)
+    client = backend.client()
+    mixed = client.files.create(file=('in.jsonl', _batch_input(('a', 'm1', 'x'), ('b', 'm2', 'y'))), purpose='batch')
+    assert client.batches.create(input_file_id=mixed.id, endpoint='/v1/chat/completions', completion_window='24h').status == 'failed'
+    with pytest.raises(openai.BadRequestError):
+        client.batches.create(input_file_id=mixed.id, endpoint='/v1/assistants', completion_window='24h')
+
+    backend.expire_batches(1)
+    upload = client.files.create(file=('in.jsonl', _batch_input(('a', 'm', 'x'))), purpose='batch')
+    batch = client.batches.create(input_file_id=upload.id, endpoint='/v1/chat/completions', completion_window='24h')
+    clock.advance(60)
+    batch = client.batches.retrieve(batch.id)
+    assert batch.status == 'expired' and batch.output_file_id is None and batch.error_file_id is None
+
+def test_active_run_blocks_new_messages_and_runs(backend):
+    client = backend.client()
+    client.beta.threads.runs.create(thread_id='t', assistant_id='a')
+    with pytest.raises(openai.BadRequestError):
+        client.beta.threads.messages.create(thread_id='t', role='user', content='more')
+    with pytest.raises(openai.BadRequestError):
+        client.beta.threads.runs.create(thread_id='t', assistant_id='a')
+
+def test_fail_runs_and_cancel(backend, clock):
+    client = backend.client()
+    backend.fail_runs(1)
+    assert _run_to_completion(client, clock, 't').status == 'failed'
+
+    run = client.beta.threads.runs.create(thread_id='t', assistant_id='a')
+    client.beta.threads.runs.cancel(thread_id='t', run_id=run.id)
+    assert client.beta.threads.runs.retrieve(thread_id='t', run_id=run.id).status == 'cancelled'
+
+def test_injected_openai_errors_are_sdk_exceptions(clock):
+    faults = FaultInjector(clock)
+    faults.fail_next('openai.runs.create', openai_error(429))
+    client = FakeOpenAIBackend(clock, faults).client()
+    with pytest.raises(openai.RateLimitError):
+        client.beta.threads.runs.create(thread_id='t', assistant_id='a')
+    assert isinstance(openai_error(503), openai.InternalServerError)
+
+def test_rate_limit_is_per_key_and_reported_to_response_hooks(clock):
+    backend = FakeOpenAIBackend(clock)
+    backend.set_rate_limit(requests_per_minute=2)
+    responses = []
+    http_client = httpx.Client(event_hooks={'response': [lambda r: responses.append((r.status_code, r.headers))]})
+    client = backend.client(api_key='sk-a', http_client=http_client)
+
+    client.beta.threads.messages.create(thread_id='t', role='user', content='one')
+    client.beta.threads.messages.create(thread_id='t', role='user', content='two')
+    with pytest.raises(openai.RateLimitError):
+        client.beta.threads.messages.create(thread_id='t', role='user', content='three')
+
+    assert [status for status, _ in responses] == [200, 200, 429]
+    assert [h['x-ratelimit-remaining-requests'] for _, h in responses] == ['1', '0', '0']
+    assert responses[2][1]['retry-after'] == '31' and responses[2][1]['retry-after-ms'] == '30001'
+    assert backend.rate_limited == 1
+    backend.client(api_key='sk-b').beta.threads.messages.create(thread_id='t', role='user', content='other key')
+    clock.advance(30)
+    client.beta.threads.messages.create(thread_id='t', role='user', content='refilled')
+
+# --- Twilio ---
+
+def test_twilio_records_sent_messages(clock):
+    backend = FakeTwilioBackend(clock)
+    backend.add_account('AC1', 'token')
+    message = backend.client('AC1', 'token').messages.create(from_='whatsapp:+1', to='whatsapp:+2', body='hi')
+    assert message.sid.startswith('SM') and message.status == 'queued' and message.body == 'hi'
+    assert backend.sent_to('whatsapp:+2') == ['hi']
+
+def test_twilio_rejects_bad_credentials_and_long_bodies(clock):
+    backend = FakeTwilioBackend(clock)
+    backend.add_account('AC1', 'token')
+    with pytest.raises(TwilioRestException) as excinfo:
+        backend.client('AC1', 'wrong').messages.create(from_='whatsapp:+1', to='whatsapp:+2', body='hi')
+    assert excinfo.value.status == 401
+    with pytest.raises(TwilioRestException) as excinfo:
+        backend.client('AC1', 'token').messages.create(from_='whatsapp:+1', to='whatsapp:+2', body='x' * 1601)
+    assert excinfo.value.code == 21617
+
+def test_twilio_fault_injection(clock):
+    faults = FaultInjector(clock)
+    faults.fail_next('twilio.messages.create', twilio_error(503))
+    backend = FakeTwilioBackend(clock, faults)
+    with pytest.raises(TwilioRestException) as excinfo:
+        backend.client('AC1', 't').messages.create(from_='whatsapp:+1', to='whatsapp:+2', body='hi')
+    assert excinfo.value.status == 503
+    assert backend.sent == []
@@ -0,0 +1,181 @@
+import pytest
+from decimal import Decimal
+from botocore.exceptions import ClientError
+from boto3.dynamodb.conditions import Key, Attr
+
+from tests.fakes import FakeDynamoDB, VirtualClock, client_error
+
+# --- Fixtures ---
+
+@pytest.fixture
+def clock():
+    return VirtualClock()
+
+@pytest.fixture
+def ddb(clock):
+    return FakeDynamoDB(clock)
+
+@pytest.fixture
+def conversations(ddb):
+    return ddb.create_table('conversations', 'primary_channel', 'conversation_id',
+                            indexes={'by-company': ('gsi_company', 'gsi_recipient')}, ttl_attribute='ttl')
+
+@pytest.fixture
+def stage(ddb):
+    return ddb.create_table('stage', 'conversation_id', 'message_sid', ttl_attribute='expires_at')
+
+def _code(excinfo):
+    return excinfo.value.response['Error']['Code']
+
+# --- Test Cases ---
+
+def test_put_get_round_trip_normalises_numbers(conversations):
+    conversations.put_item(Item={'primary_channel': 'p1', 'conversation_id': 'c1', 'count': 3, 'nested': {'n': 1}})
+    item = conversations.get_item(Key={'primary_channel': 'p1', 'conversation_id': 'c1'})['Item']
+    assert item['count'] == Decimal(3) and isinstance(item['count'], Decimal)
+    assert item['nested'] == {'n': Decimal(1)}
+
+def test_floats_rejected_like_boto3(conversations):
+    with pytest.raises(TypeError):
+        conversations.put_item(Item={'primary_channel': 'p1', 'conversation_id': 'c1', 'score': 0.5})
+
+def test_get_missing_item_returns_no_item_key(conversations):
+    assert 'Item' not in conversations.get_item(Key={'primary_channel': 'p1', 'conversation_id': 'nope'})
+
+def test_key_schema_mismatch_is_validation_error(conversations):
+    with pytest.raises(ClientError) as excinfo:
+        conversations.get_item(Key={'primary_channel': 'p1'})
+    assert _code(excinfo) == 'ValidationException'
+
+def test_conditional_put_fails_when_item_exists(stage):
+    stage.put_item(Item={'conversation_id': 'c1', 'message_sid': 'm1'},
+                   ConditionExpression='attribute_not_exists(message_sid)')
+    with pytest.raises(ClientError) as excinfo:
+        stage.put_item(Item={'conversation_id': 'c1', 'message_sid': 'm1'},
+                       ConditionExpression='attribute_not_exists(message_sid)')
+    assert _code(excinfo) == 'ConditionalCheckFailedException'
+
+def test_update_processing_lock_pattern(conversations):
+    """Same conditional update the messaging Lambda uses to take the processing lock."""
+    key = {'primary_channel': 'p1', 'conversation_id': 'c1'}
+    conversations.put_item(Item=dict(key, conversation_status='initial_message_sent'))
+    kwargs = dict(Key=key, UpdateExpression='SET conversation_status = :proc',
+                  ConditionExpression='attribute_not_exists(conversation_status) OR conversation_status <> :proc',
+                  ExpressionAttributeValues={':proc': 'processing_reply'})
+    conversations.update_item(**kwargs)
+    with pytest.raises(ClientError) as excinfo:
+        conversations.update_item(**kwargs)
+    assert _code(excinfo) == 'ConditionalCheckFailedException'
+
+def test_update_expression_clauses_and_return_values(conversations):
+    key = {'primary_channel': 'p1', 'conversation_id': 'c1'}
+    conversations.put_item(Item=dict(key, messages=[{'role': 'user'}], stale='x', counter=1))
+    response = conversations.update_item(
+        Key=key,
+        UpdateExpression='SET #msgs = list_append(if_not_exists(#msgs, :empty), :new), created = if_not_exists(created, :ts) '
+                         'REMOVE stale ADD counter :one, tags :tags',
+        ExpressionAttributeNames={'#msgs': 'messages'},
+        ExpressionAttributeValues={':empty': [], ':new': [{'role': 'assistant'}], ':ts': 't0', ':one': 1, ':tags': {'a'}},
+        ReturnValues='ALL_NEW'
+    )
+    item = response['Attributes']
+    assert [m['role'] for m in item['messages']] == ['user', 'assistant']
+    assert item['created'] == 't0' and 'stale' not in item
+    assert item['counter'] == Decimal(2) and item['tags'] == {'a'}
+
+    old = conversations.update_item(Key=key, UpdateExpression='SET counter = counter + :one',
+                                    ExpressionAttributeValues={':one': 1}, ReturnValues='UPDATED_OLD')
+    assert old['Attributes'] == {'counter': Decimal(2)}
+
+def test_update_key_attribute_rejected(conversations):
+    with pytest.raises(ClientError) as excinfo:
+        conversations.update_item(Key={'primary_channel': 'p1', 'conversation_id': 'c1'},
+                                  UpdateExpression='SET conversation_id = :v', ExpressionAttributeValues={':v': 'x'})
+    assert _code(excinfo) == 'ValidationException'
+
+def test_undefined_placeholder_is_validation_error(conversations):
+    with pytest.raises(ClientError) as excinfo:
+        conversations.update_item(Key={'primary_channel': 'p1', 'conversation_id': 'c1'},
+                                  UpdateExpression='SET a = :missing', ExpressionAttributeValues={':v': 1})
+    assert _code(excinfo) == 'ValidationException'
+
+def test_gsi_query_with_projection_and_sparse_index(conversations):
+    conversations.put_item(Item={'primary_channel': 'p1', 'conversation_id': 'c1', 'gsi_company': '+44', 'gsi_recipient': '+1',
+                                 'channel_config': {'cred': 's1'}, 'big': 'x' * 100})
+    conversations.put_item(Item={'primary_channel': 'p2', 'conversation_id': 'c2'})  # not in the index
+    response = conversations.query(IndexName='by-company',
+                                   KeyConditionExpression='gsi_company = :pk AND gsi_recipient = :sk',
+                                   ExpressionAttributeValues={':pk': '+44', ':sk': '+1'},
+                                   ProjectionExpression='channel_config, conversation_id', Limit=1)
+    assert response['Items'] == [{'channel_config': {'cred': 's1'}, 'conversation_id': 'c1'}]
+
+def test_gsi_rejects_consistent_read(conversations):
+    with pytest.raises(ClientError):
+        conversations.query(IndexName='by-company', KeyConditionExpression=Key('gsi_company').eq('+44'), ConsistentRead=True)
+
+def test_query_with_condition_objects_sorting_and_paging(stage):
+    for sid in ('m3', 'm1', 'm2'):
+        stage.put_item(Item={'conversation_id': 'c1', 'message_sid': sid, 'done': 0 if sid != 'm2' else 1})
+    stage.put_item(Item={'conversation_id': 'c2', 'message_sid': 'm9', 'done': 0})
+
+    response = stage.query(KeyConditionExpression=Key('conversation_id').eq('c1'), ConsistentRead=True)
+    assert [i['message_sid'] for i in response['Items']] == ['m1', 'm2', 'm3']
+
+    response = stage.query(KeyConditionExpression=Key('conversation_id').eq('c1'), ScanIndexForward=False, Limit=2)
+    assert [i['message_sid'] for i in response['Items']] == ['m3', 'm2']
+    following = stage.query(KeyConditionExpression=Key('conversation_id').eq('c1'), ScanIndexForward=False,
+                            ExclusiveStartKey=response['LastEvaluatedKey'])
+    assert [i['message_sid'] for i in following['Items']] == ['m1']
+
+    filtered = stage.query(KeyConditionExpression=Key('conversation_id').eq('c1') & Key('message_sid').begins_with('m'),
+                           FilterExpression=Attr('done').eq(0))
+    assert filtered['Count'] == 2 and filtered['ScannedCount'] == 3
+
+def test_limit_applies_before_filter(stage):
+    stage.put_item(Item={'conversation_id': 'c1', 'message_sid': 'm1', 'done': 1})
+    stage.put_item(Item={'conversation_id': 'c1', 'message_sid': 'm2', 'done': 0})
+    response = stage.query(KeyConditionExpression='conversation_id = :c', FilterExpression='done = :z',
+                           ExpressionAttributeValues={':c': 'c1', ':z': 0}, Limit=1)
+    assert response['Items'] == [] and 'LastEvaluatedKey' in response
+
+def test_ttl_expired_items_disappear(stage, clock):
+    stage.put_item(Item={'conversation_id': 'c1', 'message_sid': 'm1', 'expires_at': int(clock.time()) + 60})
+    assert stage.item_count() == 1
+    clock.advance(61)
+    assert stage.item_count() == 0
+    assert 'Item' not in stage.get_item(Key={'conversation_id': 'c1', 'message_sid': 'm1'})
+
+def test_ttl_delete_delay_keeps_expired_items_visible(clock):
+    table = FakeDynamoDB(clock, ttl_delete_delay=3600).create_table('t', 'pk', ttl_attribute='expires_at')
+    table.put_item(Item={'pk': 'a', 'expires_at': int(clock.time()) + 1})
+    clock.advance(120)
+    assert table.item_count() == 1
+
+def test_batch_writer_deletes(stage):
+    for sid in ('m1', 'm2'):
+        stage.put_item(Item={'conversation_id': 'c1', 'message_sid': sid})
+    with stage.batch_writer() as batch:
+        batch.delete_item(Key={'conversation_id': 'c1', 'message_sid': 'm1'})
+        batch.delete_item(Key={'conversation_id': 'c1', 'message_sid': 'm2'})
+    assert stage.item_count() == 0
+
+def test_item_size_limit(stage):
+    with pytest.raises(ClientError) as excinfo:
+        stage.put_item(Item={'conversation_id': 'c1', 'message_sid': 'm1', 'body': 'x' * (401 * 1024)})
+    assert _code(excinfo) == 'ValidationException'
+
+def test_faults_apply_to_table_calls(ddb, stage, clock):
+    ddb.faults.add_latency('dynamodb.*', 0.5)
+    ddb.faults.fail_next('dynamodb.put_item', client_error('ProvisionedThroughputExceededException'))
+    start = clock.time()
+    with pytest.raises(ClientError) as excinfo:
+        stage.put_item(Item={'conversation_id': 'c1', 'message_sid': 'm1'})
+    assert _code(excinfo) == 'ProvisionedThroughputExceededException'
+    assert clock.time() - start == pytest.approx(0.5)
+    stage.put_item(Item={'conversation_id': 'c1', 'message_sid': 'm1'})
+    assert ddb.faults.calls['dynamodb.put_item'] == 2
+
+def test_missing_table_fails_on_use(ddb):
+    with pytest.raises(ClientError) as excinfo:
+        ddb.Table('does-not-exist').get_item(Key={'pk': 'a'})
+    assert _code(excinfo) == 'ResourceNotFoundException'
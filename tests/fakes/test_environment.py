@@ -0,0 +1,633 @@
+import json
+import pytest
+from unittest.mock import ANY, patch
+
+from tests.fakes import ConcurrentVirtualClock, FakeEnvironment, client_error, openai_error, twilio_error
+
+# --- Fixtures ---
+
+@pytest.fixture
+def env():
+    """Both Lambdas wired to the fakes, on a VirtualClock, with metrics going to memory."""
+    environment = FakeEnvironment(seed=7)
+    with environment:
+        metrics_modules = (environment.staging.index.metrics, environment.messaging.index.metrics)
+        sinks = [module.set_sink(module.MemorySink()) for module in metrics_modules]
+        yield environment
+        for module, previous in zip(metrics_modules, sinks):
+            module.set_sink(previous)
+
+# --- Test Cases ---
+
+def test_webhook_to_reply_end_to_end(env):
+    conversation = env.seed_conversation()
+    response = env.send_webhook(conversation, 'Is the role still open?')
+    assert response['statusCode'] == 200
+    assert env.stage_table.item_count() == 1
+    assert env.sqs.depth(env.queue_urls['whatsapp']) == 1
+
+    responses = env.run_until_idle()
+
+    assert responses == [{'batchItemFailures': []}]
+    assert env.twilio.sent_to(conversation['whatsapp_from']) == ['Echo: Is the role still open?']
+    item = env.conversation(conversation)
+    assert item['conversation_status'] == 'reply_sent'
+    assert [m['role'] for m in item['messages']] == ['user', 'assistant']
+    assert env.stage_table.item_count() == 0
+    # The batch-window delay and the OpenAI run ran on the virtual clock
+    assert env.clock.monotonic() > env.openai.run_latency
+
+def test_fragments_within_batch_window_produce_one_reply(env):
+    conversation = env.seed_conversation()
+    for fragment in ('Hi', 'I have a question', 'about the salary'):
+        assert env.send_webhook(conversation, fragment)['statusCode'] == 200
+        env.clock.advance(1)
+
+    assert env.sqs.depth(env.queue_urls['whatsapp']) == 1
+    env.run_until_idle()
+    sent = env.twilio.sent_to(conversation['whatsapp_from'])
+    assert len(sent) == 1
+    assert 'about the salary' in sent[0]
+
+def test_invalid_signature_is_rejected_before_staging(env):
+    conversation = env.seed_conversation()
+    event = env.webhook_event(conversation, 'hello')
+    event['headers']['X-Twilio-Signature'] = 'forged'
+    response = env.staging.index.handler(event, None)
+    assert response['statusCode'] == 200 # Empty TwiML, so Twilio doesn't retry
+    assert env.stage_table.item_count() == 0
+    assert env.sqs.depth(env.queue_urls['whatsapp']) == 0
+
+def test_repeat_unknown_sender_skips_gsi_query(env):
+    conversation = env.seed_conversation()
+    stranger = dict(conversation, whatsapp_from='whatsapp:+447000000001')
+    for _ in range(3):
+        assert env.send_webhook(stranger, 'spam')['statusCode'] == 200
+    assert env.faults.calls['dynamodb.query'] == 1
+    assert env.stage_table.item_count() == 0
+
+    # Entries expire, so a conversation created later for the sender is found
+    env.clock.advance(env.staging.sender_filter.NEGATIVE_CACHE_TTL_SECONDS)
+    env.send_webhook(stranger, 'spam')
+    assert env.faults.calls['dynamodb.query'] == 2
+
+def test_throttled_dynamodb_sheds_webhooks_until_recovery(env):
+    conversation = env.seed_conversation()
+    env.faults.add_error('dynamodb.put_item', rate=1.0, error=client_error('ProvisionedThroughputExceededException'))
+    for i in range(40):
+        with pytest.raises(Exception, match='Transient server error'):
+            env.send_webhook(conversation, f"message {i}")
+
+    # Shed requests fail before the GSI lookup
+    metrics = env.staging.index.metrics.get_sink()
+    assert len(metrics.values('admission_shed')) > 0
+    assert env.faults.calls['dynamodb.query'] == 40 - len(metrics.values('admission_shed'))
+
+    env.faults.clear()
+    env.clock.advance(env.staging.admission_controller.ADMISSION_WINDOW_SECONDS)
+    assert env.send_webhook(conversation, 'recovered')['statusCode'] == 200
+    assert env.stage_table.item_count() == 1
+
+def test_company_rate_limit_rejects_excess_messages(env):
+    conversation = env.seed_conversation(rate_limits={'requests_per_minute': 2, 'requests_per_day': 100})
+    bodies = [env.send_webhook(conversation, f"message {i}")['body'] for i in range(3)]
+
+    assert 'too' not in bodies[0] and 'too' not in bodies[1]
+    assert 'faster than we can handle' in bodies[2]
+    assert env.stage_table.item_count() == 2
+    env.clock.advance(60)
+    assert 'faster' not in env.send_webhook(conversation, 'next minute')['body']
+
+def test_company_config_change_applies_without_rewriting_conversations(env):
+    conversation = env.seed_conversation()
+    env.send_webhook(conversation, 'first')
+    env.run_until_idle()
+    assert len(env.twilio.sent_to(conversation['whatsapp_from'])) == 1
+
+    env.update_company_config(project_status='paused')
+    env.clock.advance(env.staging.company_config_service.COMPANY_CONFIG_CACHE_TTL_SECONDS)
+    env.send_webhook(conversation, 'second')
+    env.run_until_idle()
+    assert len(env.twilio.sent_to(conversation['whatsapp_from'])) == 1 # Rejected as inactive
+    assert env.conversation(conversation)['project_status'] == 'active' # Conversation copy untouched
+
+KEYWORD_RULES = [
+    {'name': 'stop', 'keywords': ['STOP', 'UNSUBSCRIBE'], 'action': 'opt_out', 'reply': 'You have been unsubscribed.'},
+    {'name': 'agent', 'keywords': ['AGENT'], 'action': 'handoff', 'reply': 'Connecting you to the team.'},
+    {'name': 'ack', 'pattern': r'^(ok|okay|thanks)\W*$', 'action': 'drop'},
+]
+
+def test_keyword_rules_answer_control_messages_without_the_ai(env):
+    conversation = env.seed_conversation(keyword_rules=KEYWORD_RULES)
+
+    assert 'unsubscribed' in env.send_webhook(conversation, 'Stop.')['body']
+    assert env.send_webhook(conversation, 'ok!')['body'] == "<?xml version='1.0' encoding='UTF-8'?><Response></Response>"
+    assert env.stage_table.item_count() == 0
+    assert env.sqs.depth(env.queue_urls['whatsapp']) == 0
+    item = env.conversation(conversation)
+    assert item['comms_consent'] is False and item['comms_consent_source'] == 'keyword:stop'
+
+    # Anything else still goes to the AI
+    env.send_webhook(conversation, 'Okay, what are the hours?')
+    env.run_until_idle()
+    assert env.twilio.sent_to(conversation['whatsapp_from']) == ['Echo: Okay, what are the hours?']
+    assert env.faults.calls.get('openai.runs.create') == 1
+
+def test_keyword_handoff_rule_queues_message_for_a_human(env):
+    conversation = env.seed_conversation(keyword_rules=KEYWORD_RULES)
+    assert 'Connecting you' in env.send_webhook(conversation, 'agent')['body']
+
+    assert env.sqs.depth(env.queue_urls['handoff']) == 1
+    assert env.sqs.depth(env.queue_urls['whatsapp']) == 0
+    assert env.run_until_idle() == []
+
+def test_company_concurrency_cap_defers_second_conversation(env):
+    limits = {'concurrent_conversations': 1}
+    first = env.seed_conversation(rate_limits=limits)
+    second = env.seed_conversation(rate_limits=limits)
+    env.send_webhook(first, 'Hello?')
+    env.send_webhook(second, 'Hi?')
+    env.clock.advance(30)
+
+    # Another conversation of the same company is mid-flight in a concurrent invocation
+    dynamodb = env.messaging.dynamodb_service
+    assert dynamodb.acquire_concurrency_slot('ci-aaa-000', 'pi-aaa-000', 'in-flight', 1) == dynamodb.SEMAPHORE_ACQUIRED
+    responses = [env.deliver(max_messages=1) for _ in range(2)]
+    assert env.twilio.sent_to(first['whatsapp_from']) == []
+    assert env.twilio.sent_to(second['whatsapp_from']) == []
+    assert sum(len(r['batchItemFailures']) for r in responses) == 2
+
+    dynamodb.release_concurrency_slot('ci-aaa-000', 'pi-aaa-000', 'in-flight')
+    env.run_until_idle()
+    assert len(env.twilio.sent_to(first['whatsapp_from'])) == 1
+    assert len(env.twilio.sent_to(second['whatsapp_from'])) == 1
+    assert env.sqs.depth(env.queue_urls['whatsapp-dlq']) == 0
+
+def test_sends_from_one_number_are_paced_under_its_rate_limit(env):
+    env.openai.run_latency = 0 # Every reply is ready at the same moment
+    limits = {'sender_messages_per_second': 2}
+    conversations = [env.seed_conversation(company_number='+447000000001', rate_limits=limits) for _ in range(5)]
+    for conversation in conversations:
+        env.send_webhook(conversation, 'Is the role still open?')
+    env.clock.advance(30)
+
+    responses = env.run_until_idle()
+
+    assert all(response == {'batchItemFailures': []} for response in responses)
+    assert all(len(env.twilio.sent_to(c['whatsapp_from'])) == 1 for c in conversations)
+    first = env.twilio.sent[0]['date_created']
+    assert [m['date_created'] - first for m in env.twilio.sent] == [0, 0, 1, 1, 2]
+
+def test_twilio_rate_limit_is_retried_without_redelivery(env):
+    conversation = env.seed_conversation(rate_limits={'sender_messages_per_second': 10})
+    env.faults.fail_next('twilio.messages.create', twilio_error(429, 20429, 'Too Many Requests'))
+    env.send_webhook(conversation, 'Hello')
+
+    assert env.run_until_idle() == [{'batchItemFailures': []}]
+    assert env.twilio.sent_to(conversation['whatsapp_from']) == ['Echo: Hello']
+    assert env.openai.run_count() == 1
+
+def test_throttled_stage_write_is_retried_in_process(env):
+    conversation = env.seed_conversation()
+    seeded_writes = env.faults.calls['dynamodb.put_item']
+    env.faults.fail_next('dynamodb.put_item', client_error('ProvisionedThroughputExceededException'), times=2)
+
+    assert env.send_webhook(conversation, 'Hello')['statusCode'] == 200
+    assert env.faults.calls['dynamodb.put_item'] - seeded_writes == 3
+    assert env.run_until_idle() == [{'batchItemFailures': []}]
+    assert len(env.twilio.sent_to(conversation['whatsapp_from'])) == 1
+
+def test_non_idempotent_write_is_not_retried_after_server_error(env):
+    conversation = env.seed_conversation()
+    env.faults.fail_next('dynamodb.update_item', client_error('InternalServerError', http_status=500))
+
+    # The trigger-lock update may have been applied - the webhook is redelivered instead
+    with pytest.raises(Exception, match='TRIGGER_DB_TRANSIENT_ERROR'):
+        env.send_webhook(conversation, 'Hello')
+
+def _redeliveries_under_throttling(retries_enabled, webhooks=30):
+    """Webhook redeliveries (transient failures) and SQS record failures with 5% of AWS calls throttled."""
+    with FakeEnvironment(seed=11, retries_enabled=retries_enabled) as environment:
+        sinks = [m.set_sink(m.MemorySink()) for m in (environment.staging.index.metrics, environment.messaging.index.metrics)]
+        conversations = [environment.seed_conversation() for _ in range(webhooks)]
+        environment.faults.add_error('dynamodb.*', rate=0.05, error=lambda op: client_error('ProvisionedThroughputExceededException'))
+        environment.faults.add_error('sqs.send_message', rate=0.05, error=lambda op: client_error('RequestThrottled'))
+        webhook_failures = 0
+        for conversation in conversations:
+            try:
+                environment.send_webhook(conversation, 'Hello')
+            except Exception:
+                webhook_failures += 1
+        record_failures = sum(len(r['batchItemFailures']) for r in environment.run_until_idle())
+        for module, previous in zip((environment.staging.index.metrics, environment.messaging.index.metrics), sinks):
+            module.set_sink(previous)
+    return webhook_failures, record_failures
+
+def test_in_process_retries_reduce_redeliveries():
+    without_webhooks, without_records = _redeliveries_under_throttling(retries_enabled=False)
+    with_webhooks, with_records = _redeliveries_under_throttling(retries_enabled=True)
+
+    assert without_webhooks + without_records > 0
+    assert with_webhooks + with_records < without_webhooks + without_records
+    assert with_webhooks == 0
+
+@pytest.fixture
+def lazy_ttl_env():
+    """
+    Like env, but expired stage items stay readable for a while, as with DynamoDB's
+    background TTL deletion. Retries only happen after the 600s visibility timeout,
+    long after the staged fragments' TTL.
+    """
+    with FakeEnvironment(seed=7, ttl_delete_delay=3600) as environment:
+        yield environment
+
+def test_transient_openai_failure_retries_then_succeeds(lazy_ttl_env):
+    env = lazy_ttl_env
+    conversation = env.seed_conversation()
+    env.faults.fail_next('openai.runs.create', openai_error(429))
+    env.send_webhook(conversation, 'Hello')
+
+    responses = env.run_until_idle()
+
+    assert len(responses) == 2
+    assert responses[0]['batchItemFailures']
+    assert responses[1] == {'batchItemFailures': []}
+    assert len(env.twilio.sent_to(conversation['whatsapp_from'])) == 1
+
+def test_rate_limited_key_is_skipped_for_the_rest_of_the_pool(lazy_ttl_env):
+    env = lazy_ttl_env
+    conversation = env.seed_conversation()
+    keys = ['sk-pool-key-one', 'sk-pool-key-two']
+    env.secrets.put_secret_value(SecretId=conversation['item']['ai_config']['api_key_reference'],
+                                 SecretString=json.dumps({'ai_api_keys': keys}))
+    env.faults.fail_next('openai.runs.create', openai_error(429, headers={'retry-after': '3600'}))
+    env.send_webhook(conversation, 'Hello')
+
+    responses = env.run_until_idle()
+
+    assert [bool(r['batchItemFailures']) for r in responses] == [True, False]
+    assert env.twilio.sent_to(conversation['whatsapp_from']) == ['Echo: Hello']
+    throttled = env.messaging.key_pool.key_state(keys[0])
+    assert throttled['blocked_until'] > env.clock.time()
+    assert throttled['limit'] < env.messaging.key_pool.KEY_POOL_INITIAL_CONCURRENCY
+    assert env.openai.api_keys_seen[0] == keys[0] and env.openai.api_keys_seen[-1] == keys[1]
+
+def test_retry_after_strict_ttl_finds_no_staged_fragments(env):
+    """With TTL enforced exactly, a retried trigger finds its fragments expired and is dropped."""
+    conversation = env.seed_conversation()
+    env.faults.fail_next('openai.runs.create', openai_error(500))
+    env.send_webhook(conversation, 'Hello')
+
+    responses = env.run_until_idle()
+
+    assert [bool(r['batchItemFailures']) for r in responses] == [True, False]
+    assert env.twilio.sent == []
+
+def test_retry_after_twilio_failure_resumes_from_the_reply_outbox(env):
+    """The retry finds the fragments expired but the outbox checkpoint, and sends without a second AI run."""
+    conversation = env.seed_conversation()
+    env.faults.fail_next('twilio.messages.create', twilio_error(503))
+    env.send_webhook(conversation, 'Hello')
+
+    responses = env.run_until_idle()
+
+    assert [bool(r['batchItemFailures']) for r in responses] == [True, False]
+    assert env.twilio.sent_to(conversation['whatsapp_from']) == ['Echo: Hello']
+    assert env.openai.run_count() == 1
+    assert [m['content'] for m in env.conversation(conversation)['messages']] == ['Hello', 'Echo: Hello']
+    assert env.stage_table.item_count() == 0
+
+def test_failed_final_update_is_retried_without_sending_again(env):
+    conversation = env.seed_conversation()
+    service = env.messaging.dynamodb_service
+    update = service.update_conversation_after_reply
+    failures = iter([(service.DB_ERROR, 'Service unavailable')])
+    with patch.object(service, 'update_conversation_after_reply',
+                      side_effect=lambda **kwargs: next(failures, None) or update(**kwargs)):
+        env.send_webhook(conversation, 'Hello')
+        responses = env.run_until_idle()
+
+    assert [bool(r['batchItemFailures']) for r in responses] == [True, False]
+    assert env.twilio.sent_to(conversation['whatsapp_from']) == ['Echo: Hello']
+    assert env.openai.run_count() == 1
+    item = env.conversation(conversation)
+    assert item['conversation_status'] == 'reply_sent'
+    assert [m['role'] for m in item['messages']] == ['user', 'assistant']
+    assert env.stage_table.item_count() == 0
+
+def test_sent_outbox_left_by_failed_cleanup_is_not_stored_twice(env):
+    """A later trigger resumes the surviving outbox, but the reply is already in the history."""
+    conversation = env.seed_conversation()
+    service = env.messaging.dynamodb_service
+    cleanup = service.cleanup_staging_table
+    failures = [False]
+    with patch.object(service, 'cleanup_staging_table',
+                      side_effect=lambda keys: failures.pop() if failures else cleanup(keys)):
+        env.send_webhook(conversation, 'Hello')
+        env.run_until_idle()
+        env.send_webhook(conversation, 'Again')
+        env.run_until_idle()
+
+    assert env.twilio.sent_to(conversation['whatsapp_from']) == ['Echo: Hello', 'Echo: Again']
+    assert env.openai.run_count() == 2
+    item = env.conversation(conversation)
+    assert item['conversation_status'] == 'reply_sent'
+    assert [m['content'] for m in item['messages']] == ['Hello', 'Echo: Hello', 'Again', 'Echo: Again']
+    assert env.stage_table.item_count() == 0
+
+def test_persistent_twilio_failure_ends_in_dlq(lazy_ttl_env):
+    env = lazy_ttl_env
+    conversation = env.seed_conversation()
+    env.faults.add_error('twilio.messages.create', rate=1.0, error=lambda op: twilio_error(503))
+    env.send_webhook(conversation, 'Hello')
+
+    env.run_until_idle()
+
+    assert env.sqs.depth(env.queue_urls['whatsapp']) == 0
+    dead = env.sqs.bodies(env.queue_urls['whatsapp-dlq'])
+    assert [json.loads(body)['conversation_id'] for body in dead] == [conversation['item']['conversation_id']]
+    assert env.twilio.sent == []
+
+@pytest.fixture
+def fifo_env():
+    """Channel queues are FIFO queues: deduplicated triggers, no trigger lock."""
+    with FakeEnvironment(seed=7, channel_queue_type='fifo') as environment:
+        yield environment
+
+def test_fifo_fragments_share_one_trigger_without_trigger_lock(fifo_env):
+    env = fifo_env
+    conversation = env.seed_conversation()
+    env.clock.advance(10 - env.clock.time() % 10) # Start of a batch window
+    for fragment in ('Hi', 'I have a question', 'about the salary'):
+        assert env.send_webhook(conversation, fragment)['statusCode'] == 200
+        env.clock.advance(1)
+
+    assert env.queue_urls['whatsapp'].endswith('.fifo')
+    assert env.sqs.depth(env.queue_urls['whatsapp']) == 1
+    assert env.lock_table.item_count() == 0
+
+    assert env.run_until_idle() == [{'batchItemFailures': []}]
+    sent = env.twilio.sent_to(conversation['whatsapp_from'])
+    assert len(sent) == 1
+    assert 'Hi' in sent[0] and 'about the salary' in sent[0]
+    assert env.lock_table.item_count() == 0
+
+    # The next window gets a trigger of its own
+    env.send_webhook(conversation, 'Thanks!')
+    env.run_until_idle()
+    assert len(env.twilio.sent_to(conversation['whatsapp_from'])) == 2
+
+def test_fifo_trigger_received_early_waits_for_batch_deadline():
+    """Without the queue delay the trigger arrives at once and is hidden until its window closes."""
+    with FakeEnvironment(seed=7, channel_queue_type='fifo', fifo_queue_delay_seconds=0) as env:
+        conversation = env.seed_conversation()
+        env.clock.advance(10 - env.clock.time() % 10)
+        env.send_webhook(conversation, 'Hi')
+
+        assert env.deliver() == {'batchItemFailures': [{'itemIdentifier': ANY}]}
+        assert env.twilio.sent == []
+        env.clock.advance(2)
+        env.send_webhook(conversation, 'are you there?')
+
+        env.run_until_idle()
+        sent = env.twilio.sent_to(conversation['whatsapp_from'])
+        assert len(sent) == 1 and 'are you there?' in sent[0]
+        assert env.sqs.depth(env.queue_urls['whatsapp-dlq']) == 0
+
+def test_progressive_reply_sends_first_part_before_the_run_completes(env):
+    content = ("Thanks for your message about the role. It is still open and we would love to hear more. "
+               "Could you send your CV?")
+    env.openai.responder = lambda messages, assistant_id: json.dumps({'content': content})
+    env.openai.run_latency = 8.0
+    conversation = env.seed_conversation()
+    env.send_webhook(conversation, 'Is the role still open?')
+
+    with patch.object(env.messaging.index.progressive_reply, 'PROGRESSIVE_REPLIES_ENABLED', True):
+        assert env.run_until_idle() == [{'batchItemFailures': []}]
+
+    sent = [m for m in env.twilio.sent if m['to'] == conversation['whatsapp_from']]
+    assert [m['body'] for m in sent] == [
+        "Thanks for your message about the role. It is still open and we would love to hear more.",
+        "Could you send your CV?",
+    ]
+    assert sent[0]['date_created'] < sent[1]['date_created']
+    assistant = env.conversation(conversation)['messages'][-1]
+    assert assistant['content'] == content
+    assert assistant['message_id'] == assistant['message_sids'][0]
+    assert len(assistant['message_sids']) == 2
+    assert env.faults.calls.get('openai.runs.retrieve', 0) == 0
+    assert env.faults.calls.get('openai.messages.list', 0) == 0
+
+def test_over_length_reply_is_sent_in_ordered_parts(env):
+    conversation = env.seed_conversation()
+    question = ' '.join(f"Question {n} is about the shift pattern." for n in range(45))
+    env.send_webhook(conversation, question)
+
+    assert env.run_until_idle() == [{'batchItemFailures': []}]
+
+    sent = env.twilio.sent_to(conversation['whatsapp_from'])
+    assert len(sent) == 2
+    assert all(len(part) <= env.messaging.reply_composer.WHATSAPP_MAX_PART_CHARS for part in sent)
+    assert ' '.join(sent).split() == f"Echo: {question}".split()
+    assistant = env.conversation(conversation)['messages'][-1]
+    assert assistant['content'] == f"Echo: {question}"
+    assert len(assistant['message_sids']) == 2 and assistant['message_id'] == assistant['message_sids'][0]
+
+def _use_chat_completions(env, conversation):
+    ai_config = dict(conversation['item']['ai_config'], backend='chat_completions')
+    env.update_company_config(ai_config={'openai_config': {'whatsapp': ai_config}})
+
+def test_chat_completions_backend_builds_prompt_from_stored_history(env):
+    prompts = []
+
+    def responder(messages, assistant_id):
+        prompts.append([m['content'] for m in messages])
+        return json.dumps({'content': f"Reply {len(prompts)}"})
+    env.openai.responder = responder
+    conversation = env.seed_conversation()
+    _use_chat_completions(env, conversation)
+
+    for question in ('Is the role still open?', 'Is it remote?'):
+        env.send_webhook(conversation, question)
+        assert env.run_until_idle() == [{'batchItemFailures': []}]
+        env.clock.advance(30)
+
+    assert env.twilio.sent_to(conversation['whatsapp_from']) == ['Reply 1', 'Reply 2']
+    assert prompts[1] == ['Is the role still open?', json.dumps({'content': 'Reply 1'}), 'Is it remote?']
+    assert env.faults.calls.get('openai.chat.completions.create', 0) == 2
+    assert env.faults.calls.get('openai.assistants.retrieve', 0) == 1
+    assert env.faults.calls.get('openai.runs.create', 0) == 0
+    assert env.faults.calls.get('openai.messages.create', 0) == 0
+    history = env.conversation(conversation)['messages']
+    assert [m['content'] for m in history] == ['Is the role still open?', 'Reply 1', 'Is it remote?', 'Reply 2']
+
+def test_chat_completions_backend_streams_progressive_parts(env):
+    content = "Thanks for your message about the role. It is still open and we would love to hear more. Could you send your CV?"
+    env.openai.responder = lambda messages, assistant_id: json.dumps({'content': content})
+    env.openai.run_latency = 8.0
+    conversation = env.seed_conversation()
+    _use_chat_completions(env, conversation)
+    env.send_webhook(conversation, 'Is the role still open?')
+
+    with patch.object(env.messaging.index.progressive_reply, 'PROGRESSIVE_REPLIES_ENABLED', True):
+        assert env.run_until_idle() == [{'batchItemFailures': []}]
+
+    sent = [m for m in env.twilio.sent if m['to'] == conversation['whatsapp_from']]
+    assert len(sent) == 2 and sent[0]['date_created'] < sent[1]['date_created']
+    assert ' '.join(m['body'] for m in sent) == content
+    assert env.conversation(conversation)['messages'][-1]['content'] == content
+
+def test_context_budget_truncates_run_and_keeps_rolling_summary(env):
+    conversation = env.seed_conversation()
+    ai_config = dict(conversation['item']['ai_config'],
+                     context_window={'max_prompt_tokens': 60, 'strategy': 'summarize', 'keep_last_messages': 2})
+    env.update_company_config(ai_config={'openai_config': {'whatsapp': ai_config}})
+
+    with patch.object(env.messaging.index.context_window, 'CONTEXT_SUMMARY_MAX_TOKENS', 10):
+        for turn in range(6):
+            env.send_webhook(conversation, f"Question number {turn} about the role, the hours and the pay?")
+            assert env.run_until_idle() == [{'batchItemFailures': []}]
+            env.clock.advance(30)
+
+    item = env.conversation(conversation)
+    prompt_tokens = [int(m['prompt_tokens']) for m in item['messages'] if m['role'] == 'assistant']
+    assert prompt_tokens[2] >= 60                  # budget reached: the window starts with the next turn
+    assert max(prompt_tokens[3:]) < prompt_tokens[2] + 40
+    assert item['context_tokens'] == prompt_tokens[-1]
+    assert item['total_tokens_used'] > sum(prompt_tokens)
+    window = item['context_window']
+    assert window['strategy'] == 'summarize' and window['summary'] and window['covers'] >= 6
+    assert env.faults.calls.get('openai.chat.completions.create', 0) >= 2    # summary requests only
+
+def _use_batches(env, conversation, mode='always'):
+    ai_config = dict(conversation['item']['ai_config'], backend='chat_completions', batch_mode=mode)
+    env.update_company_config(ai_config={'openai_config': {'whatsapp': ai_config}})
+
+def test_batch_mode_reply_is_delivered_by_the_batch_runner(env):
+    conversation = env.seed_conversation()
+    _use_batches(env, conversation)
+    env.send_webhook(conversation, 'Is the role still open?')
+
+    assert env.run_until_idle() == [{'batchItemFailures': []}]
+    assert env.conversation(conversation)['conversation_status'] == 'batch_pending'
+    assert env.sqs.depth(env.queue_urls['batch']) == 1
+    assert env.run_batches() == {'submitted': 1, 'delivered': {}}
+    assert env.sqs.depth(env.queue_urls['batch']) == 0
+    assert env.twilio.sent_to(conversation['whatsapp_from']) == []
+
+    env.clock.advance(env.openai.batch_latency)
+    assert env.run_batches() == {'submitted': 0, 'delivered': {'DELIVERED': 1}}
+    assert env.twilio.sent_to(conversation['whatsapp_from']) == ['Echo: Is the role still open?']
+    item = env.conversation(conversation)
+    assert item['conversation_status'] == 'reply_sent' and 'batch_request' not in item
+    assert [m['role'] for m in item['messages']] == ['user', 'assistant']
+    assert env.stage_table.item_count() == 0
+    assert env.faults.calls.get('openai.chat.completions.create', 0) == 0
+    assert env.messaging.dynamodb_service.list_open_batches() == []
+
+def test_new_message_supersedes_pending_batch_request(env):
+    env.openai.responder = lambda messages, assistant_id: json.dumps({'content': messages[-1]['content']})
+    conversation = env.seed_conversation()
+    _use_batches(env, conversation)
+    env.send_webhook(conversation, 'Is the role still open?')
+    env.run_until_idle()
+    env.run_batches()
+    env.clock.advance(300)                         # staged fragments have expired
+
+    env.send_webhook(conversation, 'And is it remote?')
+    assert env.run_until_idle() == [{'batchItemFailures': []}]
+    env.clock.advance(env.openai.batch_latency)
+    assert env.run_batches() == {'submitted': 1, 'delivered': {'SUPERSEDED': 1}}
+    env.clock.advance(env.openai.batch_latency)
+    assert env.run_batches() == {'submitted': 0, 'delivered': {'DELIVERED': 1}}
+
+    assert env.twilio.sent_to(conversation['whatsapp_from']) == ['Is the role still open?\nAnd is it remote?']
+    assert [m['content'] for m in env.conversation(conversation)['messages']] == \
+        ['Is the role still open?\nAnd is it remote?'] * 2
+
+def test_failed_batch_request_is_reprocessed(env):
+    conversation = env.seed_conversation()
+    _use_batches(env, conversation)
+    env.send_webhook(conversation, 'Is the role still open?')
+    env.run_until_idle()
+    env.run_batches()
+    env.openai.fail_runs(1)
+    env.clock.advance(env.openai.batch_latency)
+
+    assert env.run_batches() == {'submitted': 0, 'delivered': {'RETRY': 1}}
+    assert env.conversation(conversation)['conversation_status'] == 'retry'
+    assert json.loads(env.sqs.bodies(env.queue_urls['whatsapp'])[0])['reprocess'] is True
+    env.clock.advance(300)                         # staged fragments have expired
+    assert env.run_until_idle() == [{'batchItemFailures': []}]
+    env.run_batches()
+    env.clock.advance(env.openai.batch_latency)
+    assert env.run_batches()['delivered'] == {'DELIVERED': 1}
+    assert env.twilio.sent_to(conversation['whatsapp_from']) == ['Echo: Is the role still open?']
+
+def test_reprocess_action_answers_retry_conversations_through_batches(env):
+    stuck = env.seed_conversation(conversation_status='retry')
+    _use_batches(env, stuck, mode='reprocess')
+    other_project = env.seed_conversation(project_id='pi-bbb-000', conversation_status='retry')
+    env.send_webhook(stuck, 'Is the role still open?')
+    env.clock.advance(300)                         # the original trigger was lost; fragments expired
+    env.sqs.purge_queue(QueueUrl=env.queue_urls['whatsapp'])
+    env.conversations_table.update_item(
+        Key={'primary_channel': stuck['item']['primary_channel'], 'conversation_id': stuck['item']['conversation_id']},
+        UpdateExpression="SET batch_request = :req",
+        ExpressionAttributeValues={':req': {'custom_id': 'old', 'combined_body': 'Is the role still open?',
+                                            'first_message_sid': 'SM1', 'message_sids': ['SM1']}})
+
+    assert env.run_batches({'action': 'reprocess', 'project_id': 'pi-aaa-000'}) == {'reprocess_triggers': 1}
+    assert env.run_until_idle() == [{'batchItemFailures': []}]
+    assert env.conversation(stuck)['conversation_status'] == 'batch_pending'
+    assert env.conversation(other_project)['conversation_status'] == 'retry'
+    env.run_batches()
+    env.clock.advance(env.openai.batch_latency)
+    assert env.run_batches()['delivered'] == {'DELIVERED': 1}
+    assert env.twilio.sent_to(stuck['whatsapp_from']) == ['Echo: Is the role still open?']
+
+@pytest.mark.parametrize('progressive', [False, True])
+def test_run_with_several_messages_replies_with_all_of_them(env, progressive):
+    env.openai.responder = lambda messages, assistant_id: [
+        json.dumps({'content': 'Thanks for asking.'}), ['{"content": "The role ', 'is still open."}']]
+    conversation = env.seed_conversation()
+    for _ in range(3):                             # earlier history the retrieval should not transfer
+        env.send_webhook(conversation, 'Is the role still open?')
+        env.run_until_idle()
+        env.clock.advance(30)
+    lists_before = env.faults.calls.get('openai.messages.list', 0)
+
+    env.send_webhook(conversation, 'And the salary?')
+    with patch.object(env.messaging.index.progressive_reply, 'PROGRESSIVE_REPLIES_ENABLED', progressive):
+        assert env.run_until_idle() == [{'batchItemFailures': []}]
+
+    assert env.conversation(conversation)['messages'][-1]['content'] == "Thanks for asking.\n\nThe role is still open."
+    assert env.faults.calls.get('openai.messages.list', 0) - lists_before == (0 if progressive else 1)
+
+def test_long_running_worker_replies_and_batch_deletes():
+    clock = ConcurrentVirtualClock()
+    with FakeEnvironment(clock=clock, seed=7) as env, clock.participate():
+        conversations = [env.seed_conversation() for _ in range(3)]
+        for conversation in conversations:
+            assert env.send_webhook(conversation, 'Is the role still open?')['statusCode'] == 200
+
+        worker = env.messaging.worker.SQSWorker(env.queue_urls['whatsapp'], concurrency=2, spawn=clock.spawn)
+        worker.start()
+        deadline = clock.time() + 120
+        while clock.time() < deadline and not all(env.twilio.sent_to(c['whatsapp_from']) for c in conversations):
+            clock.sleep(1)
+        worker.stop()
+        stats = worker.wait()
+
+    for conversation in conversations:
+        assert env.twilio.sent_to(conversation['whatsapp_from']) == ['Echo: Is the role still open?']
+    assert stats['succeeded'] == 3 and stats['deleted'] == 3
+    assert env.sqs.depth(env.queue_urls['whatsapp']) == 0
+    assert env.faults.calls['sqs.delete_message_batch'] >= 1
+
+def test_environment_restores_patches_on_exit():
+    environment = FakeEnvironment()
+    with environment:
+        table = environment.staging.dynamodb_service.stage_table
+        assert table is environment.stage_table
+    assert environment.staging.dynamodb_service.stage_table is not environment.stage_table
@@ -0,0 +1,160 @@
+import json
+import pytest
+from botocore.exceptions import ClientError
+
+from tests.fakes import FakeSQS, VirtualClock
+
+# --- Fixtures ---
+
+@pytest.fixture
+def clock():
+    return VirtualClock()
+
+@pytest.fixture
+def sqs(clock):
+    return FakeSQS(clock)
+
+@pytest.fixture
+def queue(sqs):
+    dlq = sqs.create_queue(QueueName='wa-dlq')['QueueUrl']
+    url = sqs.create_queue(QueueName='wa', Attributes={
+        'VisibilityTimeout': '30',
+        'RedrivePolicy': json.dumps({'deadLetterTargetArn': sqs.queue_arn(dlq), 'maxReceiveCount': '2'})
+    })['QueueUrl']
+    return url, dlq
+
+# --- Test Cases ---
+
+def test_delay_seconds_hides_message_until_due(sqs, queue, clock):
+    url, _ = queue
+    sqs.send_message(QueueUrl=url, MessageBody='hello', DelaySeconds=10)
+    assert sqs.receive_message(QueueUrl=url) == {}
+    clock.advance(10)
+    messages = sqs.receive_message(QueueUrl=url)['Messages']
+    assert messages[0]['Body'] == 'hello'
+    assert messages[0]['Attributes']['ApproximateReceiveCount'] == '1'
+
+def test_delay_above_limit_rejected(sqs, queue):
+    with pytest.raises(ClientError) as excinfo:
+        sqs.send_message(QueueUrl=queue[0], MessageBody='x', DelaySeconds=901)
+    assert excinfo.value.response['Error']['Code'] == 'InvalidParameterValue'
+
+def test_long_poll_waits_for_delayed_message(sqs, queue, clock):
+    url, _ = queue
+    sqs.send_message(QueueUrl=url, MessageBody='later', DelaySeconds=5)
+    messages = sqs.receive_message(QueueUrl=url, WaitTimeSeconds=20)['Messages']
+    assert messages[0]['Body'] == 'later'
+    assert clock.monotonic() == pytest.approx(5)
+
+def test_visibility_timeout_and_redelivery(sqs, queue, clock):
+    url, _ = queue
+    sqs.send_message(QueueUrl=url, MessageBody='m')
+    first = sqs.receive_message(QueueUrl=url)['Messages'][0]
+    assert sqs.receive_message(QueueUrl=url) == {}
+    clock.advance(30)
+    second = sqs.receive_message(QueueUrl=url)['Messages'][0]
+    assert second['MessageId'] == first['MessageId']
+    assert second['ReceiptHandle'] != first['ReceiptHandle']
+    assert second['Attributes']['ApproximateReceiveCount'] == '2'
+
+def test_change_visibility_extends_in_flight_message(sqs, queue, clock):
+    url, _ = queue
+    sqs.send_message(QueueUrl=url, MessageBody='m')
+    handle = sqs.receive_message(QueueUrl=url)['Messages'][0]['ReceiptHandle']
+    sqs.change_message_visibility(QueueUrl=url, ReceiptHandle=handle, VisibilityTimeout=600)
+    clock.advance(300)
+    assert sqs.receive_message(QueueUrl=url) == {}
+    clock.advance(300)
+    assert sqs.receive_message(QueueUrl=url)['Messages']
+
+def test_change_visibility_on_expired_handle_fails(sqs, queue, clock):
+    url, _ = queue
+    sqs.send_message(QueueUrl=url, MessageBody='m')
+    handle = sqs.receive_message(QueueUrl=url)['Messages'][0]['ReceiptHandle']
+    clock.advance(31)
+    with pytest.raises(ClientError):
+        sqs.change_message_visibility(QueueUrl=url, ReceiptHandle=handle, VisibilityTimeout=60)
+
+def test_delete_removes_message(sqs, queue):
+    url, _ = queue
+    sqs.send_message(QueueUrl=url, MessageBody='m')
+    handle = sqs.receive_message(QueueUrl=url)['Messages'][0]['ReceiptHandle']
+    sqs.delete_message(QueueUrl=url, ReceiptHandle=handle)
+    assert sqs.depth(url) == 0
+
+def test_redrive_moves_message_to_dlq_after_max_receives(sqs, queue, clock):
+    url, dlq = queue
+    sqs.send_message(QueueUrl=url, MessageBody='poison')
+    for _ in range(2):
+        assert sqs.receive_message(QueueUrl=url)['Messages']
+        clock.advance(30)
+    assert sqs.receive_message(QueueUrl=url) == {}
+    assert sqs.bodies(dlq) == ['poison']
+
+def test_queue_attributes_report_counts(sqs, queue):
+    url, _ = queue
+    sqs.send_message(QueueUrl=url, MessageBody='a')
+    sqs.send_message(QueueUrl=url, MessageBody='b', DelaySeconds=60)
+    sqs.receive_message(QueueUrl=url)
+    attributes = sqs.get_queue_attributes(QueueUrl=url, AttributeNames=['All'])['Attributes']
+    assert attributes['ApproximateNumberOfMessagesNotVisible'] == '1'
+    assert attributes['ApproximateNumberOfMessagesDelayed'] == '1'
+
+def test_fifo_orders_groups_and_deduplicates(sqs, clock):
+    url = sqs.create_queue(QueueName='wa.fifo', Attributes={'ContentBasedDeduplication': 'true'})['QueueUrl']
+    sqs.send_message(QueueUrl=url, MessageBody='a1', MessageGroupId='a')
+    sqs.send_message(QueueUrl=url, MessageBody='a1', MessageGroupId='a')   # duplicate within 5 minutes
+    sqs.send_message(QueueUrl=url, MessageBody='a2', MessageGroupId='a')
+    sqs.send_message(QueueUrl=url, MessageBody='b1', MessageGroupId='b')
+    assert sqs.depth(url) == 3
+
+    first = sqs.receive_message(QueueUrl=url, MaxNumberOfMessages=10)['Messages']
+    # One receive may take several messages of a group, in send order
+    assert [m['Body'] for m in first] == ['a1', 'a2', 'b1']
+    assert first[0]['Attributes']['MessageGroupId'] == 'a'
+
+    # While any of them is in flight, later messages of that group are held back
+    sqs.send_message(QueueUrl=url, MessageBody='a3', MessageGroupId='a')
+    assert sqs.receive_message(QueueUrl=url, MaxNumberOfMessages=10) == {}
+    for message in first[:2]:
+        sqs.delete_message(QueueUrl=url, ReceiptHandle=message['ReceiptHandle'])
+    assert [m['Body'] for m in sqs.receive_message(QueueUrl=url, MaxNumberOfMessages=10)['Messages']] == ['a3']
+
+def test_fifo_redelivers_failed_head_before_the_rest_of_its_group(sqs, clock):
+    url = sqs.create_queue(QueueName='wa.fifo', Attributes={'VisibilityTimeout': '30'})['QueueUrl']
+    for body in ('a1', 'a2'):
+        sqs.send_message(QueueUrl=url, MessageBody=body, MessageGroupId='a', MessageDeduplicationId=body)
+    head = sqs.receive_message(QueueUrl=url)['Messages'][0]
+    assert head['Body'] == 'a1'
+    assert sqs.receive_message(QueueUrl=url) == {}    # a2 waits behind the in-flight a1
+
+    clock.advance(30)
+    assert [m['Body'] for m in sqs.receive_message(QueueUrl=url)['Messages']] == ['a1']
+
+def test_fifo_rejects_per_message_delay_and_missing_group(sqs):
+    url = sqs.create_queue(QueueName='wa.fifo', Attributes={'ContentBasedDeduplication': 'true'})['QueueUrl']
+    for kwargs, code in (({'MessageGroupId': 'a', 'DelaySeconds': 10}, 'InvalidParameterValue'),
+                         ({}, 'MissingParameter')):
+        with pytest.raises(ClientError) as excinfo:
+            sqs.send_message(QueueUrl=url, MessageBody='x', **kwargs)
+        assert excinfo.value.response['Error']['Code'] == code
+
+def test_fifo_queue_delay_and_deduplication_window(sqs, clock):
+    url = sqs.create_queue(QueueName='wa.fifo', Attributes={'DelaySeconds': '10'})['QueueUrl']
+    sqs.send_message(QueueUrl=url, MessageBody='t1', MessageGroupId='a', MessageDeduplicationId='conv:10:0')
+    assert sqs.receive_message(QueueUrl=url) == {}    # the queue's own delay still applies
+    clock.advance(10)
+    received = sqs.receive_message(QueueUrl=url)['Messages']
+    sqs.delete_message(QueueUrl=url, ReceiptHandle=received[0]['ReceiptHandle'])
+
+    # Still a duplicate after the delete, until the 5 minute window has passed
+    sqs.send_message(QueueUrl=url, MessageBody='t2', MessageGroupId='a', MessageDeduplicationId='conv:10:0')
+    assert sqs.depth(url) == 0
+    clock.advance(300)
+    sqs.send_message(QueueUrl=url, MessageBody='t3', MessageGroupId='a', MessageDeduplicationId='conv:10:0')
+    assert sqs.bodies(url) == ['t3']
+
+def test_unknown_queue(sqs):
+    with pytest.raises(ClientError) as excinfo:
+        sqs.send_message(QueueUrl='https://sqs.eu-north-1.amazonaws.com/000000000000/nope', MessageBody='x')
+    assert excinfo.value.response['Error']['Code'] == 'AWS.SimpleQueueService.NonExistentQueue'
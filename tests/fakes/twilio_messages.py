@@ -0,0 +1,98 @@
+"""
+In-memory stand-in for the Twilio REST client (messages.create only).
+
+    backend = FakeTwilioBackend(clock, faults)
+    client = backend.client(account_sid, auth_token)    # what twilio.rest.Client(...) returns
+    client.messages.create(from_='whatsapp:+4600000000', to='whatsapp:+4611111111', body='hi')
+    backend.sent                                        # every accepted message, in order
+
+Messages sent with credentials that don't match a registered account fail with
+a 401 TwilioRestException (code 20003), like the real API.
+"""
+
+import itertools
+import threading
+from types import SimpleNamespace
+
+from twilio.base.exceptions import TwilioRestException
+
+from .clock import RealClock
+from .faults import FaultInjector
+
+MAX_BODY_LENGTH = 1600
+
+
+def twilio_error(status, code=None, message=None):
+    """Builds the TwilioRestException the SDK raises for an HTTP status (e.g. 429 / code 20429)."""
+    return TwilioRestException(
+        status=status,
+        uri='/2010-04-01/Accounts/ACfake/Messages.json',
+        msg=message or f"Simulated Twilio error {status}",
+        code=code if code is not None else 20000 + status,
+        method='POST'
+    )
+
+
+class FakeTwilioBackend:
+    """Records messages sent through any fake client."""
+
+    def __init__(self, clock=None, faults=None):
+        self.clock = clock or RealClock()
+        self.faults = faults or FaultInjector(self.clock)
+        self.accounts = {}      # account_sid -> auth_token; empty means accept any credentials
+        self.sent = []
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def add_account(self, account_sid, auth_token):
+        self.accounts[account_sid] = auth_token
+
+    def client(self, account_sid=None, auth_token=None, *args, **kwargs):
+        """Returns an object shaped like twilio.rest.Client(account_sid, auth_token)."""
+        return FakeTwilioClient(self, account_sid, auth_token)
+
+    def create_message(self, account_sid, auth_token, from_, to, body, **kwargs):
+        self.faults.inject('twilio.messages.create')
+        if self.accounts and self.accounts.get(account_sid) != auth_token:
+            raise twilio_error(401, 20003, 'Authenticate')
+        if not body:
+            raise twilio_error(400, 21602, 'Message body is required.')
+        if len(body) > MAX_BODY_LENGTH:
+            raise twilio_error(400, 21617, 'The concatenated message body exceeds the 1600 character limit.')
+        if from_.startswith('whatsapp:') != to.startswith('whatsapp:'):
+            raise twilio_error(400, 63007, 'Twilio could not find a Channel with the specified From address')
+
+        with self._lock:
+            record = {
+                'sid': f"SM{next(self._ids):032d}",
+                'account_sid': account_sid,
+                'from': from_,
+                'to': to,
+                'body': body,
+                'status': 'queued',
+                'date_created': self.clock.time(),
+            }
+            self.sent.append(record)
+        return SimpleNamespace(sid=record['sid'], status=record['status'], body=body,
+                               from_=from_, to=to, account_sid=account_sid, error_code=None)
+
+    def sent_to(self, to):
+        """Bodies of messages sent to one recipient, in order."""
+        with self._lock:
+            return [m['body'] for m in self.sent if m['to'] == to]
+
+
+class _Messages:
+    def __init__(self, backend, account_sid, auth_token):
+        self._backend = backend
+        self._account_sid = account_sid
+        self._auth_token = auth_token
+
+    def create(self, to, from_=None, body=None, **kwargs):
+        return self._backend.create_message(self._account_sid, self._auth_token, from_, to, body, **kwargs)
+
+
+class FakeTwilioClient:
+    def __init__(self, backend, account_sid, auth_token):
+        self.account_sid = account_sid
+        self.messages = _Messages(backend, account_sid, auth_token)
@@ -0,0 +1,131 @@
+"""
+AI Backend Comparison
+
+Runs the same multi-turn conversation through the messaging Lambda once per AI
+backend (core/ai_backend.py) on the offline stand-ins, and reports per reply:
+
+    reply_seconds        messaging handler start -> reply sent (virtual clock)
+    openai_calls         OpenAI API calls made, by operation
+    prompt_tokens        as recorded on the assistant history entry
+
+Both backends get the same generation time (--generation-seconds) and the same
+network latency per OpenAI call (--call-latency), so the difference comes from
+the request pattern: add message + create run + polls (1s apart) + list
+messages for threads, and one chat.completions call for chat_completions
+(plus one assistants.retrieve per warm container).
+
+Usage:
+    python -m tests.perf.ai_backend_comparison
+    python -m tests.perf.ai_backend_comparison --turns 50 --generation-seconds 4 --call-latency 0.2
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import logging
+import sys
+from collections import Counter
+from unittest.mock import patch
+
+from tests.fakes import FakeEnvironment
+
+DEFAULT_TURNS = 20
+DEFAULT_GENERATION_SECONDS = 2.0
+DEFAULT_CALL_LATENCY = 0.15
+BACKENDS = ('threads', 'chat_completions')
+
+
+def _percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))]
+
+
+def run_backend(backend, turns=DEFAULT_TURNS, generation_seconds=DEFAULT_GENERATION_SECONDS,
+                call_latency=DEFAULT_CALL_LATENCY, seed=1):
+    """Runs `turns` request/reply turns with one backend and returns its measurements."""
+    env = FakeEnvironment(seed=seed, openai_run_latency=generation_seconds)
+    env.faults.add_latency('openai.*', call_latency)
+    reply_seconds = []
+
+    with env, contextlib.redirect_stdout(io.StringIO()), \
+            patch.object(env.messaging.ai_backend, 'AI_BACKEND_DEFAULT', backend):
+        for module in (env.staging.index.metrics, env.messaging.index.metrics):
+            module.set_sink(module.MemorySink())
+        index = env.messaging.index
+        handler = index.handler
+        started = []
+
+        def timed_handler(event, context):
+            started.append(env.clock.time())
+            return handler(event, context)
+
+        conversation = env.seed_conversation()
+        calls_before = Counter({k: v for k, v in env.faults.calls.items() if k.startswith('openai.')})
+        with patch.object(index, 'handler', timed_handler):
+            for turn in range(turns):
+                env.send_webhook(conversation, f"Question {turn}: is the role still open?")
+                sent_before = len(env.twilio.sent_to(conversation['whatsapp_from']))
+                env.run_until_idle()
+                replies = [m for m in env.twilio.sent if m['to'] == conversation['whatsapp_from']]
+                if len(replies) > sent_before:
+                    reply_seconds.append(replies[sent_before]['date_created'] - started[-1])
+                env.clock.advance(30)
+
+        calls = Counter({k: v for k, v in env.faults.calls.items() if k.startswith('openai.')}) - calls_before
+        history = env.conversation(conversation)['messages']
+
+    prompt_tokens = [int(m['prompt_tokens']) for m in history if m['role'] == 'assistant']
+    replies = len(reply_seconds)
+    return {
+        'replies': replies,
+        'mean_reply_seconds': round(sum(reply_seconds) / replies, 3) if replies else None,
+        'p95_reply_seconds': round(_percentile(reply_seconds, 95), 3) if replies else None,
+        'openai_calls_per_reply': round(sum(calls.values()) / replies, 2) if replies else None,
+        'openai_calls': dict(sorted(calls.items())),
+        'mean_prompt_tokens': round(sum(prompt_tokens) / len(prompt_tokens), 1) if prompt_tokens else None,
+        'last_prompt_tokens': prompt_tokens[-1] if prompt_tokens else None,
+    }
+
+
+def run(turns=DEFAULT_TURNS, generation_seconds=DEFAULT_GENERATION_SECONDS, call_latency=DEFAULT_CALL_LATENCY, seed=1):
+    """Runs every backend and returns the report dict."""
+    previous_disable = logging.root.manager.disable
+    logging.disable(logging.WARNING)
+    try:
+        results = {backend: run_backend(backend, turns, generation_seconds, call_latency, seed) for backend in BACKENDS}
+    finally:
+        logging.disable(previous_disable)
+    threads, chat = results['threads'], results['chat_completions']
+    speedup = None
+    if threads['mean_reply_seconds'] and chat['mean_reply_seconds']:
+        speedup = round(threads['mean_reply_seconds'] / chat['mean_reply_seconds'], 2)
+    return {
+        'turns': turns,
+        'generation_seconds': generation_seconds,
+        'call_latency_seconds': call_latency,
+        'backends': results,
+        'reply_speedup': speedup,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare reply latency and OpenAI calls of the AI backends.")
+    parser.add_argument('--turns', type=int, default=DEFAULT_TURNS, help="Request/reply turns per backend")
+    parser.add_argument('--generation-seconds', type=float, default=DEFAULT_GENERATION_SECONDS,
+                        help="Time the model takes to generate a reply")
+    parser.add_argument('--call-latency', type=float, default=DEFAULT_CALL_LATENCY,
+                        help="Network latency added to every OpenAI call")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    report = run(args.turns, args.generation_seconds, args.call_latency, args.seed)
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
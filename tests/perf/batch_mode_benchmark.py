@@ -0,0 +1,157 @@
+"""
+Batch Mode Benchmark
+
+Answers a burst of --conversations inbound messages (one per conversation, all
+in one project, so they share one OpenAI key limited to --requests-per-minute)
+through the messaging Lambda on the offline stand-ins, once per mode:
+
+    interactive   chat_completions backend, one request per reply
+    batch         ai_config.batch_mode 'always': requests are parked on the
+                  batch queue, batch_runner.py submits them as one OpenAI batch
+                  (ending --batch-seconds later) and delivers the results; the
+                  runner is invoked every --runner-interval seconds
+
+Reported per mode: replies delivered, OpenAI API calls, 429 responses, tokens,
+cost at --input-price / --output-price per million tokens (batch requests at
+BATCH_PRICE_FACTOR of that, as OpenAI bills them), replies per dollar, and
+reply time (webhook -> reply sent, virtual clock). Batch mode trades reply
+time for cost and rate-limit headroom.
+
+Usage:
+    python -m tests.perf.batch_mode_benchmark
+    python -m tests.perf.batch_mode_benchmark --conversations 200 --requests-per-minute 60 --batch-seconds 1800
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import logging
+import sys
+from collections import Counter
+
+from tests.fakes import FakeEnvironment
+
+DEFAULT_CONVERSATIONS = 60
+DEFAULT_REQUESTS_PER_MINUTE = 30
+DEFAULT_GENERATION_SECONDS = 2.0
+DEFAULT_BATCH_SECONDS = 900.0
+DEFAULT_RUNNER_INTERVAL = 60.0
+DEFAULT_INPUT_PRICE = 0.15      # USD per 1M prompt tokens (gpt-4o-mini)
+DEFAULT_OUTPUT_PRICE = 0.60     # USD per 1M completion tokens
+BATCH_PRICE_FACTOR = 0.5
+MODES = ('interactive', 'batch')
+_MAX_RUNNER_INVOCATIONS = 1000
+
+
+def _percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))]
+
+
+def run_mode(mode, conversations=DEFAULT_CONVERSATIONS, requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE,
+             generation_seconds=DEFAULT_GENERATION_SECONDS, batch_seconds=DEFAULT_BATCH_SECONDS,
+             runner_interval=DEFAULT_RUNNER_INTERVAL, input_price=DEFAULT_INPUT_PRICE,
+             output_price=DEFAULT_OUTPUT_PRICE, seed=1):
+    """Answers the burst in one mode and returns its measurements."""
+    env = FakeEnvironment(seed=seed, openai_run_latency=generation_seconds)
+    env.openai.batch_latency = batch_seconds
+    env.openai.set_rate_limit(requests_per_minute)
+
+    with env, contextlib.redirect_stdout(io.StringIO()):
+        for module in (env.staging.index.metrics, env.messaging.index.metrics):
+            module.set_sink(module.MemorySink())
+        seeded = [env.seed_conversation() for _ in range(conversations)]
+        # The project's config is the last seeded conversation's: one OpenAI key for all of them
+        ai_config = dict(seeded[-1]['item']['ai_config'], backend='chat_completions')
+        if mode == 'batch':
+            ai_config['batch_mode'] = 'always'
+        env.update_company_config(ai_config={'openai_config': {'whatsapp': ai_config}})
+
+        started = env.clock.time()
+        for n, conversation in enumerate(seeded):
+            env.send_webhook(conversation, f"Question {n}: is the role still open, and what are the hours?")
+        env.run_until_idle()
+        if mode == 'batch':
+            for _ in range(_MAX_RUNNER_INVOCATIONS):
+                env.run_batches()
+                if len(env.twilio.sent) >= conversations or not (env.sqs.depth(env.queue_urls['batch'])
+                                                                  or env.messaging.dynamodb_service.list_open_batches()):
+                    break
+                env.clock.advance(runner_interval)
+
+        reply_seconds = [m['date_created'] - started for m in env.twilio.sent]
+        history = [m for conversation in seeded for m in env.conversation(conversation)['messages'] if m['role'] == 'assistant']
+        calls = Counter({k: v for k, v in env.faults.calls.items() if k.startswith('openai.')})
+
+    prompt_tokens = sum(int(m['prompt_tokens']) for m in history)
+    completion_tokens = sum(int(m['completion_tokens']) for m in history)
+    cost = (prompt_tokens * input_price + completion_tokens * output_price) / 1e6
+    if mode == 'batch':
+        cost *= BATCH_PRICE_FACTOR
+    replies = len(history)
+    return {
+        'replies': replies,
+        'openai_calls': sum(calls.values()),
+        'openai_calls_by_operation': dict(sorted(calls.items())),
+        'rate_limited_responses': env.openai.rate_limited,
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'cost_usd': round(cost, 6),
+        'replies_per_dollar': round(replies / cost, 1) if cost else None,
+        'mean_reply_seconds': round(sum(reply_seconds) / len(reply_seconds), 1) if reply_seconds else None,
+        'p95_reply_seconds': round(_percentile(reply_seconds, 95), 1) if reply_seconds else None,
+    }
+
+
+def run(conversations=DEFAULT_CONVERSATIONS, requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE,
+        generation_seconds=DEFAULT_GENERATION_SECONDS, batch_seconds=DEFAULT_BATCH_SECONDS,
+        runner_interval=DEFAULT_RUNNER_INTERVAL, input_price=DEFAULT_INPUT_PRICE, output_price=DEFAULT_OUTPUT_PRICE,
+        seed=1, modes=MODES):
+    """Runs every mode and returns the report dict."""
+    previous_disable = logging.root.manager.disable
+    logging.disable(logging.WARNING)
+    try:
+        results = {mode: run_mode(mode, conversations, requests_per_minute, generation_seconds, batch_seconds,
+                                  runner_interval, input_price, output_price, seed)
+                   for mode in modes}
+    finally:
+        logging.disable(previous_disable)
+    interactive, batch = results.get('interactive'), results.get('batch')
+    ratio = None
+    if interactive and batch and interactive['replies_per_dollar'] and batch['replies_per_dollar']:
+        ratio = round(batch['replies_per_dollar'] / interactive['replies_per_dollar'], 2)
+    return {
+        'conversations': conversations,
+        'requests_per_minute': requests_per_minute,
+        'batch_seconds': batch_seconds,
+        'runner_interval_seconds': runner_interval,
+        'modes': results,
+        'replies_per_dollar_ratio': ratio,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare interactive and OpenAI Batch API replies for a burst of messages.")
+    parser.add_argument('--conversations', type=int, default=DEFAULT_CONVERSATIONS)
+    parser.add_argument('--requests-per-minute', type=int, default=DEFAULT_REQUESTS_PER_MINUTE, help="Limit of the project's key")
+    parser.add_argument('--generation-seconds', type=float, default=DEFAULT_GENERATION_SECONDS)
+    parser.add_argument('--batch-seconds', type=float, default=DEFAULT_BATCH_SECONDS, help="Time until a batch ends")
+    parser.add_argument('--runner-interval', type=float, default=DEFAULT_RUNNER_INTERVAL, help="Seconds between batch runner invocations")
+    parser.add_argument('--input-price', type=float, default=DEFAULT_INPUT_PRICE, help="USD per 1M prompt tokens")
+    parser.add_argument('--output-price', type=float, default=DEFAULT_OUTPUT_PRICE, help="USD per 1M completion tokens")
+    parser.add_argument('--mode', action='append', choices=MODES, help="Mode to run (repeatable, default all)")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    report = run(args.conversations, args.requests_per_minute, args.generation_seconds, args.batch_seconds,
+                 args.runner_interval, args.input_price, args.output_price, args.seed, tuple(args.mode or MODES))
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
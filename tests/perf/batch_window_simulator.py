@@ -0,0 +1,202 @@
+"""
+Batch Window Simulator
+
+Replays recorded fragment timings through the staging Lambda's batch window
+policy and reports the latency / split-batch trade-off for a fixed window
+versus the adaptive window (core/batch_window.py).
+
+Input is JSONL, one conversation per line:
+
+    {"conversation_id": "c1", "fragments": [{"t": 0.0, "body": "hi,"}, {"t": 2.4, "body": "can you help?"}]}
+
+where "t" is seconds since the start of the recording.
+
+Model (mirrors staging + messaging Lambdas):
+    * The first fragment of a batch acquires the trigger lock and picks DelaySeconds.
+    * Fragments arriving before the trigger fires join the batch.
+    * When the trigger fires the conversation is processing for PROCESSING_SECONDS;
+      fragments arriving in that interval are rejected (CONVERSATION_LOCKED) and
+      recorded as splits on the lock item.
+    * A fragment arriving after processing that is within TURN_GAP_SECONDS of the
+      previous fragment opens a new batch for the same turn - also a split batch.
+    * When a batch is processed its timing stats are folded into the lock item,
+      exactly as cleanup_trigger_lock does.
+
+Usage:
+    python -m tests.perf.batch_window_simulator tests/perf/data/fragment_timings_sample.jsonl
+    python -m tests.perf.batch_window_simulator timings.jsonl --fixed-window 10 --processing-seconds 8
+"""
+
+import argparse
+import json
+import math
+import sys
+
+from src.staging_lambda.lambda_pkg.core import batch_window
+
+DEFAULT_PROCESSING_SECONDS = 8.0
+DEFAULT_TURN_GAP_SECONDS = 30.0
+
+
+def load_recordings(path):
+    """Reads a JSONL recording file into a list of conversations."""
+    conversations = []
+    with open(path, 'r') as f:
+        for line_no, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"{path}:{line_no}: invalid JSON ({e})")
+            fragments = sorted(record.get('fragments', []), key=lambda fr: float(fr['t']))
+            conversations.append({
+                'conversation_id': record.get('conversation_id', f'conv_{line_no}'),
+                'fragments': fragments
+            })
+    return conversations
+
+
+def fixed_policy(window_seconds):
+    """Policy returning the same DelaySeconds for every trigger (the old behaviour)."""
+    def _policy(body, batch_stats):
+        return window_seconds
+    return _policy
+
+
+def adaptive_policy(body, batch_stats):
+    """Policy used by the staging Lambda."""
+    return batch_window.choose_delay_seconds(body, batch_stats)
+
+
+def _fold_batch(stats, batch):
+    """Adds a processed batch to the lock-item counters (see cleanup_trigger_lock)."""
+    times_ms = [int(round(fr['t'] * 1000)) for fr in batch]
+    gaps = [b - a for a, b in zip(times_ms, times_ms[1:])]
+    stats['batch_count'] = stats.get('batch_count', 0) + 1
+    stats['fragment_count'] = stats.get('fragment_count', 0) + len(batch)
+    stats['gap_sum_ms'] = stats.get('gap_sum_ms', 0) + sum(gaps)
+    stats['gap_count'] = stats.get('gap_count', 0) + len(gaps)
+    stats['last_fragment_at_ms'] = times_ms[-1]
+
+
+def simulate_conversation(fragments, policy, processing_seconds=DEFAULT_PROCESSING_SECONDS,
+                          turn_gap_seconds=DEFAULT_TURN_GAP_SECONDS):
+    """
+    Runs one conversation through the given policy.
+
+    Returns:
+        dict with 'batches' (list of batch dicts), 'rejected' (fragment count) and
+        'split_batches' (batches that continued a turn already flushed).
+    """
+    stats = {}
+    batches = []
+    rejected = 0
+    split_batches = 0
+
+    batch = None            # fragments of the open batch
+    flush_at = None         # when the trigger message becomes visible
+    busy_until = None       # end of processing for the last flushed batch
+    prev_t = None
+
+    def close_batch():
+        nonlocal batch, busy_until
+        batches.append({
+            'fragments': len(batch),
+            'delay_seconds': flush_at - batch[0]['t'],
+            'latency_seconds': flush_at - batch[-1]['t']
+        })
+        _fold_batch(stats, batch)
+        busy_until = flush_at + processing_seconds
+        batch = None
+
+    for fragment in fragments:
+        t = float(fragment['t'])
+        fragment = {'t': t, 'body': fragment.get('body', '')}
+
+        if batch is not None and t > flush_at:
+            close_batch()
+
+        if batch is not None:
+            batch.append(fragment)
+        elif busy_until is not None and t < busy_until:
+            rejected += 1
+            stats['split_count'] = stats.get('split_count', 0) + 1
+        else:
+            if prev_t is not None and busy_until is not None and (t - prev_t) <= turn_gap_seconds:
+                split_batches += 1
+            delay = policy(fragment['body'], dict(stats))
+            batch = [fragment]
+            flush_at = t + delay
+        prev_t = t
+
+    if batch is not None:
+        close_batch()
+
+    return {'batches': batches, 'rejected': rejected, 'split_batches': split_batches}
+
+
+def _percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, int(math.ceil(pct / 100.0 * len(ordered))) - 1)
+    return round(ordered[index], 3)
+
+
+def summarize(results):
+    """Aggregates per-conversation results into a report."""
+    latencies = [b['latency_seconds'] for r in results for b in r['batches']]
+    delays = [b['delay_seconds'] for r in results for b in r['batches']]
+    batch_total = len(latencies)
+    split_total = sum(r['split_batches'] for r in results)
+    rejected_total = sum(r['rejected'] for r in results)
+    return {
+        'conversations': len(results),
+        'batches': batch_total,
+        'latency_mean_seconds': round(sum(latencies) / batch_total, 3) if batch_total else None,
+        'latency_p50_seconds': _percentile(latencies, 50),
+        'latency_p95_seconds': _percentile(latencies, 95),
+        'delay_mean_seconds': round(sum(delays) / batch_total, 3) if batch_total else None,
+        'split_batches': split_total,
+        'rejected_fragments': rejected_total,
+        'split_rate': round((split_total + rejected_total) / batch_total, 4) if batch_total else 0.0
+    }
+
+
+def run(conversations, fixed_window=None, processing_seconds=DEFAULT_PROCESSING_SECONDS,
+        turn_gap_seconds=DEFAULT_TURN_GAP_SECONDS):
+    """Simulates fixed and adaptive policies over the same recordings."""
+    fixed_window = batch_window.BATCH_WINDOW_SECONDS if fixed_window is None else fixed_window
+    report = {}
+    for name, policy in (('fixed', fixed_policy(fixed_window)), ('adaptive', adaptive_policy)):
+        results = [
+            simulate_conversation(c['fragments'], policy, processing_seconds, turn_gap_seconds)
+            for c in conversations
+        ]
+        report[name] = summarize(results)
+    report['fixed']['window_seconds'] = fixed_window
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay fragment timings against fixed and adaptive batch windows.")
+    parser.add_argument('recordings', help="JSONL file of recorded fragment timings")
+    parser.add_argument('--fixed-window', type=int, default=None,
+                        help="Fixed window to compare against (default: BATCH_WINDOW_SECONDS)")
+    parser.add_argument('--processing-seconds', type=float, default=DEFAULT_PROCESSING_SECONDS,
+                        help="Time the conversation stays locked after a trigger fires")
+    parser.add_argument('--turn-gap-seconds', type=float, default=DEFAULT_TURN_GAP_SECONDS,
+                        help="Gap after which a fragment is treated as a new turn")
+    args = parser.parse_args(argv)
+
+    conversations = load_recordings(args.recordings)
+    report = run(conversations, args.fixed_window, args.processing_seconds, args.turn_gap_seconds)
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
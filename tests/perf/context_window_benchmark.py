@@ -0,0 +1,174 @@
+"""
+Context Window Benchmark
+
+Runs one long synthetic conversation (default 200 turns) through the messaging
+Lambda on the offline stand-ins, once per context strategy
+(core/context_window.py), and reports how prompt tokens and reply latency
+develop over the conversation (the middle of the conversation is compared with
+its end):
+
+    none       no budget: the whole thread is sent every turn
+    truncate   last keep_last_messages entries once over budget
+    summarize  rolling summary + recent entries once over budget
+
+The fake model takes `--generation-seconds` plus `--prompt-token-latency`
+seconds per 1000 prompt tokens, so latency follows prompt size the way it does
+on the real API. Reply latency is messaging handler start -> reply sent, on
+the virtual clock.
+
+Usage:
+    python -m tests.perf.context_window_benchmark
+    python -m tests.perf.context_window_benchmark --turns 200 --budget 3000 --keep 10 --backend chat_completions
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import logging
+import sys
+from unittest.mock import patch
+
+from tests.fakes import FakeEnvironment
+
+DEFAULT_TURNS = 200
+DEFAULT_BUDGET = 3000
+DEFAULT_KEEP = 10
+DEFAULT_GENERATION_SECONDS = 1.5
+DEFAULT_PROMPT_TOKEN_LATENCY = 0.4
+STRATEGIES = ('none', 'truncate', 'summarize')
+REPLY_SENTENCE = "Thanks, noted. The role is full time in Leeds with a hybrid pattern and the team meets on Tuesdays. "
+
+
+def _responder(messages, assistant_id):
+    """A ~400 character reply that mentions the latest message, like a real assistant turn."""
+    latest = next((m['content'] for m in reversed(messages) if m['role'] == 'user'), '')
+    return json.dumps({'content': f"About '{latest[:40]}': " + REPLY_SENTENCE * 3})
+
+
+def _mean(values):
+    return round(sum(values) / len(values), 3) if values else None
+
+
+def run_strategy(strategy, turns=DEFAULT_TURNS, budget=DEFAULT_BUDGET, keep=DEFAULT_KEEP, backend='threads',
+                 generation_seconds=DEFAULT_GENERATION_SECONDS, prompt_token_latency=DEFAULT_PROMPT_TOKEN_LATENCY, seed=1):
+    """Runs `turns` request/reply turns with one strategy and returns per-turn prompt tokens and latency."""
+    env = FakeEnvironment(seed=seed, openai_run_latency=generation_seconds)
+    env.openai.prompt_token_latency = prompt_token_latency
+    env.openai.responder = _responder
+    reply_seconds = []
+
+    with env, contextlib.redirect_stdout(io.StringIO()):
+        for module in (env.staging.index.metrics, env.messaging.index.metrics):
+            module.set_sink(module.MemorySink())
+        index = env.messaging.index
+        handler = index.handler
+        started = []
+
+        def timed_handler(event, context):
+            started.append(env.clock.time())
+            return handler(event, context)
+
+        conversation = env.seed_conversation()
+        ai_config = dict(conversation['item']['ai_config'], backend=backend)
+        if strategy != 'none':
+            ai_config['context_window'] = {'max_prompt_tokens': budget, 'strategy': strategy, 'keep_last_messages': keep}
+        env.update_company_config(ai_config={'openai_config': {'whatsapp': ai_config}})
+
+        with patch.object(index, 'handler', timed_handler):
+            for turn in range(turns):
+                env.send_webhook(conversation, f"Turn {turn}: I'd also like to know about parking, start dates and "
+                                               f"whether the salary band can move for the right person.")
+                sent_before = len(env.twilio.sent_to(conversation['whatsapp_from']))
+                env.run_until_idle()
+                replies = [m for m in env.twilio.sent if m['to'] == conversation['whatsapp_from']]
+                if len(replies) > sent_before:
+                    reply_seconds.append(replies[sent_before]['date_created'] - started[-1])
+                env.clock.advance(30)
+
+        item = env.conversation(conversation)
+        summary_calls = env.faults.calls.get('openai.chat.completions.create', 0)
+        if backend == 'chat_completions':
+            summary_calls -= len(reply_seconds)
+
+    prompt_tokens = [int(m['prompt_tokens']) for m in item['messages'] if m['role'] == 'assistant']
+    return {
+        'prompt_tokens': prompt_tokens,
+        'reply_seconds': [round(s, 3) for s in reply_seconds],
+        'summary_calls': summary_calls,
+        'total_tokens_used': int(item.get('total_tokens_used', 0)),
+        'context_window': {k: int(v) if k == 'covers' else v for k, v in (item.get('context_window') or {}).items()
+                           if k != 'summary'},
+    }
+
+
+def summarize(result, window=20):
+    """Prompt tokens at a few turns, and the means over the middle and the last `window` turns."""
+    tokens, seconds = result['prompt_tokens'], result['reply_seconds']
+    window = max(1, min(window, len(tokens) // 4))
+    middle = slice(len(tokens) // 2 - window, len(tokens) // 2)
+    late = slice(-window, None)
+    checkpoints = sorted({n for n in (10, 25, 50, 100, 150, 200, len(tokens)) if 0 < n <= len(tokens)})
+    report = {
+        'turns': len(tokens),
+        'prompt_tokens_at_turn': {n: tokens[n - 1] for n in checkpoints},
+        'prompt_tokens_middle': _mean(tokens[middle]),
+        'prompt_tokens_late': _mean(tokens[late]),
+        'prompt_tokens_max': max(tokens) if tokens else None,
+        'reply_seconds_middle': _mean(seconds[middle]),
+        'reply_seconds_late': _mean(seconds[late]),
+        'summary_calls': result['summary_calls'],
+        'total_tokens_used': result['total_tokens_used'],
+        'context_window': result['context_window'],
+    }
+    if report['prompt_tokens_middle']:
+        report['prompt_tokens_growth'] = round(report['prompt_tokens_late'] / report['prompt_tokens_middle'], 2)
+    if report['reply_seconds_middle']:
+        report['reply_seconds_growth'] = round(report['reply_seconds_late'] / report['reply_seconds_middle'], 2)
+    return report
+
+
+def run(turns=DEFAULT_TURNS, budget=DEFAULT_BUDGET, keep=DEFAULT_KEEP, backend='threads',
+        generation_seconds=DEFAULT_GENERATION_SECONDS, prompt_token_latency=DEFAULT_PROMPT_TOKEN_LATENCY,
+        seed=1, strategies=STRATEGIES):
+    """Runs every strategy and returns the report dict."""
+    previous_disable = logging.root.manager.disable
+    logging.disable(logging.WARNING)
+    try:
+        results = {strategy: summarize(run_strategy(strategy, turns, budget, keep, backend, generation_seconds,
+                                                    prompt_token_latency, seed))
+                   for strategy in strategies}
+    finally:
+        logging.disable(previous_disable)
+    return {
+        'turns': turns,
+        'budget': budget,
+        'keep_last_messages': keep,
+        'backend': backend,
+        'strategies': results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Prompt tokens and reply latency over a long conversation, per context strategy.")
+    parser.add_argument('--turns', type=int, default=DEFAULT_TURNS)
+    parser.add_argument('--budget', type=int, default=DEFAULT_BUDGET, help="max_prompt_tokens")
+    parser.add_argument('--keep', type=int, default=DEFAULT_KEEP, help="keep_last_messages")
+    parser.add_argument('--backend', default='threads', choices=('threads', 'chat_completions'))
+    parser.add_argument('--generation-seconds', type=float, default=DEFAULT_GENERATION_SECONDS)
+    parser.add_argument('--prompt-token-latency', type=float, default=DEFAULT_PROMPT_TOKEN_LATENCY,
+                        help="Seconds per 1000 prompt tokens")
+    parser.add_argument('--strategy', action='append', choices=STRATEGIES,
+                        help="Strategy to run (repeatable, default all)")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    report = run(args.turns, args.budget, args.keep, args.backend, args.generation_seconds,
+                 args.prompt_token_latency, args.seed, tuple(args.strategy or STRATEGIES))
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,192 @@
+"""
+DynamoDB Microbenchmark
+
+Measures the client-side CPU cost of the per-request DynamoDB calls made
+through the boto3 resource layer (Table.get_item etc.) versus the low-level
+client path in services/dynamodb_lowlevel.py.
+
+Both paths run on real boto3 clients (the resource's, and a plain client for
+the low-level path) whose responses are pre-loaded with botocore's Stubber, so
+parameter validation, the resource layer's
+TypeSerializer / TypeDeserializer event handlers and the low-level marshalling
+all run, but no request leaves the process. Each operation mirrors a call on
+the hot path:
+
+    get_item    get_full_conversation / get_conversation_item (projected read)
+    query       the credential lookup on a conversations GSI
+    put_item    write_to_stage_table
+    update_item acquire_trigger_lock (conditional, ReturnValues=ALL_OLD)
+
+Reported times are process CPU microseconds per call (mean over --iterations).
+
+Usage:
+    python -m tests.perf.dynamodb_microbenchmark
+    python -m tests.perf.dynamodb_microbenchmark --iterations 20000 --messages 40
+"""
+
+import argparse
+import copy
+import json
+import sys
+import time
+from decimal import Decimal
+
+import boto3
+from botocore.stub import Stubber
+
+from src.staging_lambda.lambda_pkg.services import dynamodb_lowlevel
+
+DEFAULT_ITERATIONS = 2000
+DEFAULT_MESSAGES = 10
+TABLE_NAME = 'benchmark-table'
+INDEX_NAME = 'company-id-project-id-index'
+KEY_CONDITION = 'company_id = :pk AND project_id = :sk'
+LOCK_UPDATE = 'SET trigger_expires_at = :trigger_exp, expires_at = :exp'
+LOCK_CONDITION = 'attribute_not_exists(trigger_expires_at) OR trigger_expires_at < :now'
+CONVERSATION_FIELDS = ('conversation_id', 'conversation_status', 'messages', 'channel_config', 'task_complete')
+
+
+def build_fixtures(message_count=DEFAULT_MESSAGES):
+    """Python-side request values and the items the stubbed table returns."""
+    conversation = {
+        'conversation_id': 'conv_benchmark',
+        'conversation_status': 'processing',
+        'task_complete': 0,
+        'channel_config': {'whatsapp_credentials_id': 'secret/whatsapp/benchmark', 'company_whatsapp_number': '+4400000000'},
+        'messages': [
+            {'role': 'user' if i % 2 == 0 else 'assistant', 'content': f'message body {i} ' * 8,
+             'timestamp': '2024-01-01T12:00:00+00:00', 'message_sid': f'SM{i:032d}'}
+            for i in range(message_count)
+        ],
+    }
+    stage_item = {
+        'conversation_id': 'conv_benchmark',
+        'message_sid': 'SM' + '0' * 32,
+        'primary_channel': '+4400000000',
+        'body': 'hello, can you help me with my booking?',
+        'received_at': '2024-01-01T12:00:00+00:00',
+        'received_at_ms': 1704110400000,
+        'expires_at': 1704110500,
+    }
+    lock_item = {'conversation_id': 'conv_benchmark', 'expires_at': 1704110500, 'batch_count': 4, 'gap_sum_ms': 9000, 'gap_count': 3}
+    return {
+        'key': {'primary_channel': '+4400000000', 'conversation_id': 'conv_benchmark'},
+        'conversation': conversation,
+        'gsi_values': {':pk': 'ci-aaa-000', ':sk': 'pi-aaa-000'},
+        'stage_item': stage_item,
+        'lock_key': {'conversation_id': 'conv_benchmark'},
+        'lock_values': {':trigger_exp': 1704110480, ':exp': 1704714400, ':now': 1704110400},
+        'lock_item': lock_item,
+    }
+
+
+def _responses(fixtures):
+    """Wire-format responses for each operation."""
+    wire = dynamodb_lowlevel.serialize_item
+    return {
+        'get_item': {'Item': wire(fixtures['conversation'])},
+        'query': {'Items': [wire(fixtures['conversation'])], 'Count': 1, 'ScannedCount': 1},
+        'put_item': {},
+        'update_item': {'Attributes': wire(fixtures['lock_item'])},
+    }
+
+
+def _operations(fixtures):
+    """operation -> (resource-layer call taking a Table, low-level call taking a client)."""
+    projection, names = dynamodb_lowlevel.projection(CONVERSATION_FIELDS)
+    return {
+        'get_item': (
+            lambda table: table.get_item(
+                Key=fixtures['key'], ProjectionExpression=projection, ExpressionAttributeNames=names
+            ).get('Item'),
+            lambda client: dynamodb_lowlevel.get_item(
+                client, TABLE_NAME, fixtures['key'], attributes=CONVERSATION_FIELDS
+            ),
+        ),
+        'query': (
+            lambda table: table.query(
+                IndexName=INDEX_NAME, KeyConditionExpression=KEY_CONDITION,
+                ExpressionAttributeValues=fixtures['gsi_values'], Limit=1
+            ).get('Items', []),
+            lambda client: dynamodb_lowlevel.query(
+                client, TABLE_NAME, KEY_CONDITION, fixtures['gsi_values'], index_name=INDEX_NAME, limit=1
+            ),
+        ),
+        'put_item': (
+            lambda table: table.put_item(Item=fixtures['stage_item']).get('Attributes'),
+            lambda client: dynamodb_lowlevel.put_item(client, TABLE_NAME, fixtures['stage_item']),
+        ),
+        'update_item': (
+            lambda table: table.update_item(
+                Key=fixtures['lock_key'], UpdateExpression=LOCK_UPDATE, ConditionExpression=LOCK_CONDITION,
+                ExpressionAttributeValues=fixtures['lock_values'], ReturnValues='ALL_OLD'
+            ).get('Attributes', {}),
+            lambda client: dynamodb_lowlevel.update_item(
+                client, TABLE_NAME, fixtures['lock_key'], LOCK_UPDATE, condition=LOCK_CONDITION,
+                values=fixtures['lock_values'], return_values='ALL_OLD'
+            ),
+        ),
+    }
+
+
+def _stubbed(layer):
+    """A Table ('resource') or plain client ('lowlevel') on an offline client, plus its Stubber."""
+    session = boto3.session.Session(region_name='eu-north-1', aws_access_key_id='benchmark', aws_secret_access_key='benchmark')
+    if layer == 'resource':
+        target = session.resource('dynamodb').Table(TABLE_NAME)
+        stubber = Stubber(target.meta.client)
+    else:
+        target = session.client('dynamodb')
+        stubber = Stubber(target)
+    stubber.activate()
+    return target, stubber
+
+
+def measure(fn, layer, response, operation, iterations):
+    """Mean process CPU microseconds per call, and the last result."""
+    target, stubber = _stubbed(layer)
+    for _ in range(iterations + 1):
+        # The resource layer deserializes responses in place - every call needs its own
+        stubber.add_response(operation, copy.deepcopy(response))
+    result = fn(target) # Warm-up: loads service models and caches
+    started = time.process_time()
+    for _ in range(iterations):
+        fn(target)
+    elapsed = time.process_time() - started
+    stubber.deactivate()
+    return round(elapsed / iterations * 1_000_000, 1), result
+
+
+def run(iterations=DEFAULT_ITERATIONS, message_count=DEFAULT_MESSAGES):
+    """Times every operation on both paths. Also reports whether both returned the same values."""
+    fixtures = build_fixtures(message_count)
+    responses = _responses(fixtures)
+    report = {'iterations': iterations, 'messages': message_count, 'operations': {}}
+    for operation, (resource_call, lowlevel_call) in _operations(fixtures).items():
+        resource_us, resource_result = measure(resource_call, 'resource', responses[operation], operation, iterations)
+        lowlevel_us, lowlevel_result = measure(lowlevel_call, 'lowlevel', responses[operation], operation, iterations)
+        report['operations'][operation] = {
+            'resource_us_per_call': resource_us,
+            'lowlevel_us_per_call': lowlevel_us,
+            'speedup': round(resource_us / lowlevel_us, 2) if lowlevel_us else None,
+            'same_result': resource_result == lowlevel_result,
+        }
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare resource-layer and low-level DynamoDB call CPU cost.")
+    parser.add_argument('--iterations', type=int, default=DEFAULT_ITERATIONS,
+                        help="Calls timed per operation and path")
+    parser.add_argument('--messages', type=int, default=DEFAULT_MESSAGES,
+                        help="Messages in the conversation item read back by get_item / query")
+    args = parser.parse_args(argv)
+
+    report = run(args.iterations, args.messages)
+    json.dump(report, sys.stdout, indent=2, default=lambda value: str(value) if isinstance(value, Decimal) else None)
+    sys.stdout.write('\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,204 @@
+"""
+Key Pool Benchmark
+
+Sends a steady stream of replies through openai_service.process_reply_with_ai
+on the offline OpenAI stand-in, where every API key is limited to
+--requests-per-minute, and compares how the keys are used (core/key_pool.py):
+
+    single_key    one key, no scheduling (a project with one ai_api_key)
+    round_robin   --keys keys taken in turn, no scheduling
+    pool          --keys keys leased through key_pool: rate limit headers,
+                  retry-after and per-key AIMD concurrency limits
+
+--workers threads take replies off a queue, like the long-running worker's
+shards. A reply that fails with a transient error (RateLimitError), or finds
+no usable key, is redelivered after --redelivery-seconds, like an SQS message
+after its visibility timeout. Everything runs on a ConcurrentVirtualClock.
+
+Reported per mode: 429 responses, redeliveries, reply time (arrival -> reply
+generated, including redeliveries) and the time to finish the whole stream.
+
+Usage:
+    python -m tests.perf.key_pool_benchmark
+    python -m tests.perf.key_pool_benchmark --replies 300 --arrival-rate 3.5 --keys 3 --requests-per-minute 240
+"""
+
+import argparse
+import contextlib
+import json
+import logging
+import sys
+import threading
+from unittest.mock import patch
+
+import openai
+
+from tests.fakes import ConcurrentVirtualClock, FakeOpenAIBackend, FaultInjector
+from src.messaging_lambda.whatsapp.lambda_pkg.core import key_pool, openai_service
+
+DEFAULT_REPLIES = 300
+DEFAULT_ARRIVAL_RATE = 3.5          # replies per second (above what one key sustains)
+DEFAULT_KEYS = 3
+DEFAULT_REQUESTS_PER_MINUTE = 240   # per key
+DEFAULT_WORKERS = 16
+DEFAULT_RUN_SECONDS = 3.0
+DEFAULT_CALL_LATENCY = 0.1
+DEFAULT_REDELIVERY_SECONDS = 60.0
+MODES = ('single_key', 'round_robin', 'pool')
+
+
+def _percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))]
+
+
+class _Queue:
+    """Replies waiting to be processed, each visible from its `ready_at`."""
+
+    def __init__(self, replies, arrival_rate, start):
+        self.lock = threading.Lock()
+        self.pending = [{'n': n, 'arrived': start + n / arrival_rate, 'ready_at': start + n / arrival_rate, 'attempts': 0}
+                        for n in range(replies)]
+        self.done = []
+        self.total = replies
+
+    def take(self, now):
+        with self.lock:
+            ready = [job for job in self.pending if job['ready_at'] <= now]
+            if not ready:
+                return None, (min(job['ready_at'] for job in self.pending) - now) if self.pending else None
+            job = min(ready, key=lambda j: j['ready_at'])
+            self.pending.remove(job)
+            return job, None
+
+    def put_back(self, job, ready_at):
+        with self.lock:
+            job['ready_at'] = ready_at
+            self.pending.append(job)
+
+    def finish(self, job, now):
+        with self.lock:
+            job['finished'] = now
+            self.done.append(job)
+
+    def finished(self):
+        with self.lock:
+            return len(self.done) == self.total
+
+
+def _worker(mode, keys, queue, clock, redelivery_seconds, counter):
+    while not queue.finished():
+        job, wait = queue.take(clock.time())
+        if job is None:
+            clock.sleep(min(wait, 0.5) if wait is not None else 0.5)
+            continue
+        job['attempts'] += 1
+        if mode == 'pool':
+            lease = key_pool.lease(keys)
+        else:
+            with counter['lock']:
+                index = counter['next'] % len(keys)
+                counter['next'] += 1
+            lease = contextlib.nullcontext(keys[index])
+        with lease as api_key:
+            status = openai_service.AI_TRANSIENT_ERROR
+            if api_key is not None:
+                status, _ = openai_service.process_reply_with_ai(f"thread_{job['n']}", 'asst_bench', f"Question {job['n']}", api_key)
+        if status == openai_service.AI_SUCCESS:
+            queue.finish(job, clock.time())
+        elif status == openai_service.AI_TRANSIENT_ERROR:
+            queue.put_back(job, clock.time() + redelivery_seconds)
+        else:
+            job['failed'] = status
+            queue.finish(job, clock.time())
+
+
+def run_mode(mode, replies=DEFAULT_REPLIES, arrival_rate=DEFAULT_ARRIVAL_RATE, keys=DEFAULT_KEYS,
+             requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE, workers=DEFAULT_WORKERS, run_seconds=DEFAULT_RUN_SECONDS,
+             call_latency=DEFAULT_CALL_LATENCY, redelivery_seconds=DEFAULT_REDELIVERY_SECONDS, seed=1):
+    """Processes the reply stream with one mode and returns its measurements."""
+    clock = ConcurrentVirtualClock()
+    faults = FaultInjector(clock, seed=seed)
+    faults.add_latency('openai.*', call_latency)
+    backend = FakeOpenAIBackend(clock, faults, run_latency=run_seconds, seed=seed)
+    backend.set_rate_limit(requests_per_minute)
+    api_keys = [f"sk-bench-{n}" for n in range(1 if mode == 'single_key' else keys)]
+    queue = _Queue(replies, arrival_rate, clock.time())
+    counter = {'lock': threading.Lock(), 'next': 0}
+    started = clock.time()
+
+    with patch.object(openai, 'OpenAI', backend.client), \
+            patch.object(openai_service, 'time', clock), \
+            patch.object(key_pool, 'time', clock), \
+            patch.object(key_pool, '_keys', {}), \
+            patch.object(key_pool, '_http_clients', {}), \
+            patch.object(key_pool, 'KEY_POOL_ENABLED', mode == 'pool'), \
+            clock.participate():
+        threads = [clock.spawn(_worker, mode, api_keys, queue, clock, redelivery_seconds, counter) for _ in range(workers)]
+        while any(thread.is_alive() for thread in threads):
+            clock.sleep(1.0)
+        limits = {key[-1]: round(key_pool.key_state(key)['limit'], 2) for key in api_keys} if mode == 'pool' else None
+
+    reply_seconds = [job['finished'] - job['arrived'] for job in queue.done if 'failed' not in job]
+    attempts = sum(job['attempts'] for job in queue.done)
+    return {
+        'keys': len(api_keys),
+        'replies': len(reply_seconds),
+        'failed': sum(1 for job in queue.done if 'failed' in job),
+        'rate_limited_responses': backend.rate_limited,
+        'redeliveries': attempts - len(queue.done),
+        'mean_reply_seconds': round(sum(reply_seconds) / len(reply_seconds), 2) if reply_seconds else None,
+        'p95_reply_seconds': round(_percentile(reply_seconds, 95), 2) if reply_seconds else None,
+        'finished_after_seconds': round(max((job['finished'] for job in queue.done), default=started) - started, 1),
+        'concurrency_limits': limits,
+    }
+
+
+def run(replies=DEFAULT_REPLIES, arrival_rate=DEFAULT_ARRIVAL_RATE, keys=DEFAULT_KEYS,
+        requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE, workers=DEFAULT_WORKERS, run_seconds=DEFAULT_RUN_SECONDS,
+        call_latency=DEFAULT_CALL_LATENCY, redelivery_seconds=DEFAULT_REDELIVERY_SECONDS, seed=1, modes=MODES):
+    """Runs every mode and returns the report dict."""
+    previous_disable = logging.root.manager.disable
+    logging.disable(logging.WARNING)
+    try:
+        results = {mode: run_mode(mode, replies, arrival_rate, keys, requests_per_minute, workers, run_seconds,
+                                  call_latency, redelivery_seconds, seed)
+                   for mode in modes}
+    finally:
+        logging.disable(previous_disable)
+    return {
+        'replies': replies,
+        'arrival_rate_per_second': arrival_rate,
+        'requests_per_minute_per_key': requests_per_minute,
+        'workers': workers,
+        'run_seconds': run_seconds,
+        'redelivery_seconds': redelivery_seconds,
+        'modes': results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare single-key, round-robin and scheduled key pool usage under rate limits.")
+    parser.add_argument('--replies', type=int, default=DEFAULT_REPLIES)
+    parser.add_argument('--arrival-rate', type=float, default=DEFAULT_ARRIVAL_RATE, help="Replies per second")
+    parser.add_argument('--keys', type=int, default=DEFAULT_KEYS, help="Keys in the pool")
+    parser.add_argument('--requests-per-minute', type=int, default=DEFAULT_REQUESTS_PER_MINUTE, help="Limit per key")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS)
+    parser.add_argument('--run-seconds', type=float, default=DEFAULT_RUN_SECONDS)
+    parser.add_argument('--call-latency', type=float, default=DEFAULT_CALL_LATENCY)
+    parser.add_argument('--redelivery-seconds', type=float, default=DEFAULT_REDELIVERY_SECONDS)
+    parser.add_argument('--mode', action='append', choices=MODES, help="Mode to run (repeatable, default all)")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    report = run(args.replies, args.arrival_rate, args.keys, args.requests_per_minute, args.workers, args.run_seconds,
+                 args.call_latency, args.redelivery_seconds, args.seed, tuple(args.mode or MODES))
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
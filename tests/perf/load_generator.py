@@ -0,0 +1,323 @@
+"""
+Replies Pipeline Load Generator
+
+Drives the real staging and messaging handlers end to end against the offline
+stand-ins in tests/fakes, and reports throughput and latency as JSON so runs
+can be compared across commits.
+
+Workload model:
+    * `conversations` WhatsApp conversations start at random offsets within
+      `ramp_seconds`. Each runs `turns` user turns.
+    * A turn is a burst of 1-5 fragments (most turns are a single message),
+      separated by short typing gaps. Each fragment is a correctly signed Twilio
+      webhook (RequestValidator algorithm) sent to the staging handler.
+    * After a turn the user waits for the reply, then thinks for a while before
+      the next turn.
+    * `consumers` pollers stand in for the SQS event source mapping. Each one
+      long-polls the WhatsApp queue with BatchSize 1 (as in template.yaml) and
+      invokes the messaging handler.
+
+Everything runs on a ConcurrentVirtualClock. Service latencies are simulated
+(see DEFAULT_LATENCIES), so a run that covers many minutes of traffic finishes
+in seconds of wall time. Webhook latency = simulated service time + the
+handler's own CPU time (thread_time), so Python-side regressions show up too.
+
+Usage:
+    python -m tests.perf.load_generator --conversations 200 --turns 3 --output run.json
+    python -m tests.perf.load_generator --compare baseline.json run.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import logging
+import math
+import random
+import subprocess
+import sys
+import threading
+import time
+
+from tests.fakes import ConcurrentVirtualClock, FakeEnvironment
+
+# Simulated service latency: operation pattern -> (seconds, jitter seconds)
+DEFAULT_LATENCIES = {
+    'dynamodb.*': (0.006, 0.003),
+    'sqs.*': (0.012, 0.005),
+    'secretsmanager.*': (0.025, 0.010),
+    'openai.messages.*': (0.150, 0.050),
+    'openai.runs.*': (0.120, 0.040),
+    'twilio.*': (0.180, 0.060),
+}
+DEFAULT_OPENAI_RUN_SECONDS = 3.5
+DEFAULT_OPENAI_RUN_JITTER = 1.5
+
+# Fragments per turn: most users send one message, some send a burst
+FRAGMENT_COUNT_WEIGHTS = [(1, 0.55), (2, 0.2), (3, 0.13), (4, 0.08), (5, 0.04)]
+TYPING_GAP_MEAN_SECONDS = 2.5
+THINK_TIME_SECONDS = (20.0, 90.0)
+REPLY_TIMEOUT_SECONDS = 300.0
+CONSUMER_WAIT_SECONDS = 20
+
+LOCKED_TWIML_MARKER = 'processing your previous message'
+
+SAMPLE_FRAGMENTS = [
+    'hi', 'hello,', 'quick question', 'about the role', 'is it still open?', 'what is the salary',
+    'and is it remote', 'thanks!', 'ok', 'I can start next month.', 'can we talk tomorrow?'
+]
+
+
+# --- Workload ---
+
+def build_workload(conversations, turns, ramp_seconds, seed=None):
+    """Returns one plan per conversation: start offset plus a list of turns, each a list of (gap, body)."""
+    rng = random.Random(seed)
+    counts, weights = zip(*FRAGMENT_COUNT_WEIGHTS)
+    plans = []
+    for _ in range(conversations):
+        plan_turns = []
+        for _ in range(turns):
+            fragments = []
+            for i in range(rng.choices(counts, weights)[0]):
+                gap = 0.0 if i == 0 else round(rng.expovariate(1.0 / TYPING_GAP_MEAN_SECONDS), 3)
+                fragments.append((gap, rng.choice(SAMPLE_FRAGMENTS)))
+            plan_turns.append({'fragments': fragments, 'think_seconds': round(rng.uniform(*THINK_TIME_SECONDS), 3)})
+        plans.append({'start': round(rng.uniform(0, ramp_seconds), 3), 'turns': plan_turns})
+    return plans
+
+
+# --- Statistics ---
+
+def _percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, int(math.ceil(pct / 100.0 * len(ordered))) - 1)
+    return round(ordered[index], 3)
+
+
+def _distribution(values):
+    return {
+        'count': len(values),
+        'mean': round(sum(values) / len(values), 3) if values else None,
+        'p50': _percentile(values, 50),
+        'p95': _percentile(values, 95),
+        'p99': _percentile(values, 99),
+        'max': round(max(values), 3) if values else None,
+    }
+
+
+# --- Run ---
+
+class _Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.webhook_ms = []
+        self.webhook_cpu_ms = []
+        self.webhook_statuses = {}
+        self.reply_seconds = []
+        self.turns_unanswered = 0
+        self.fragments_sent = 0
+        self.invocations = 0
+        self.invocation_failures = 0
+
+    def count_status(self, status):
+        with self.lock:
+            self.webhook_statuses[status] = self.webhook_statuses.get(status, 0) + 1
+
+
+def _classify(response):
+    if response is None:
+        return 'error'
+    body = response.get('body') or ''
+    if response.get('statusCode') == 200 and LOCKED_TWIML_MARKER in body:
+        return 'locked'
+    return 'accepted' if response.get('statusCode') == 200 else f"http_{response.get('statusCode')}"
+
+
+def _wait_for_reply(env, recipient, since):
+    """Polls the Twilio stand-in for the first reply sent to `recipient` at or after `since`."""
+    deadline = env.clock.time() + REPLY_TIMEOUT_SECONDS
+    while True:
+        replies = [m for m in list(env.twilio.sent) if m['to'] == recipient and m['date_created'] >= since]
+        if replies or env.clock.time() >= deadline:
+            return replies[0] if replies else None
+        env.clock.sleep(1.0)
+
+
+def _run_conversation(env, plan, recorder):
+    clock = env.clock
+    clock.sleep(plan['start'])
+    seeded = env.seed_conversation()
+    recipient = seeded['whatsapp_from']
+
+    for turn in plan['turns']:
+        last_sent_at = None
+        for gap, body in turn['fragments']:
+            clock.sleep(gap)
+            started = clock.time()
+            cpu_started = time.thread_time()
+            try:
+                response = env.send_webhook(seeded, body)
+            except Exception:
+                # Transient errors are raised so API Gateway returns 5xx and Twilio retries
+                response = None
+            cpu_ms = (time.thread_time() - cpu_started) * 1000.0
+            status = _classify(response)
+            with recorder.lock:
+                recorder.fragments_sent += 1
+                recorder.webhook_cpu_ms.append(cpu_ms)
+                recorder.webhook_ms.append((clock.time() - started) * 1000.0 + cpu_ms)
+            recorder.count_status(status)
+            if status == 'accepted':
+                last_sent_at = clock.time()
+
+        if last_sent_at is None:
+            clock.sleep(turn['think_seconds'])
+            continue
+
+        reply = _wait_for_reply(env, recipient, last_sent_at)
+        with recorder.lock:
+            if reply is not None:
+                recorder.reply_seconds.append(reply['date_created'] - last_sent_at)
+            else:
+                recorder.turns_unanswered += 1
+        clock.sleep(turn['think_seconds'])
+
+
+def _run_consumer(env, stop, recorder):
+    while not stop.is_set():
+        response = env.deliver('whatsapp', max_messages=1, wait_seconds=CONSUMER_WAIT_SECONDS)
+        if response is None:
+            continue
+        with recorder.lock:
+            recorder.invocations += 1
+            recorder.invocation_failures += len(response.get('batchItemFailures', []))
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def run(conversations=50, turns=3, ramp_seconds=60.0, consumers=5, seed=1,
+        openai_run_seconds=DEFAULT_OPENAI_RUN_SECONDS, latencies=None):
+    """Runs one load test and returns the report dict."""
+    latencies = DEFAULT_LATENCIES if latencies is None else latencies
+    plans = build_workload(conversations, turns, ramp_seconds, seed)
+    clock = ConcurrentVirtualClock()
+    env = FakeEnvironment(clock=clock, seed=seed, openai_run_latency=openai_run_seconds, ttl_delete_delay=3600)
+    env.openai.run_latency_jitter = DEFAULT_OPENAI_RUN_JITTER if openai_run_seconds else 0.0
+    for pattern, (seconds, jitter) in latencies.items():
+        env.faults.add_latency(pattern, seconds, jitter)
+
+    recorder = _Recorder()
+    stop = threading.Event()
+    wall_started = time.perf_counter()
+
+    # Lambda logging and EMF output would dominate the run; keep them out of the report
+    previous_disable = logging.root.manager.disable
+    logging.disable(logging.WARNING)
+    try:
+        with env, contextlib.redirect_stdout(io.StringIO()), clock.participate():
+            for module in (env.staging.index.metrics, env.messaging.index.metrics):
+                module.set_sink(module.MemorySink())
+            senders = [clock.spawn(_run_conversation, env, plan, recorder) for plan in plans]
+            for _ in range(consumers):
+                clock.spawn(_run_consumer, env, stop, recorder)
+            while any(thread.is_alive() for thread in senders):
+                clock.sleep(1.0)
+            simulated_seconds = clock.monotonic()
+            stop.set()
+            clock.sleep(CONSUMER_WAIT_SECONDS + 1)   # Let pollers finish their last long poll
+    finally:
+        logging.disable(previous_disable)
+
+    wall_seconds = time.perf_counter() - wall_started
+    ddb_calls = {op: n for op, n in sorted(env.faults.calls.items()) if op.startswith('dynamodb.')}
+    replies = len(env.twilio.sent)
+    return {
+        'git_commit': _git_commit(),
+        'config': {
+            'conversations': conversations, 'turns': turns, 'ramp_seconds': ramp_seconds,
+            'consumers': consumers, 'seed': seed, 'openai_run_seconds': openai_run_seconds,
+        },
+        'fragments_sent': recorder.fragments_sent,
+        'webhook_outcomes': dict(sorted(recorder.webhook_statuses.items())),
+        'webhook_latency_ms': _distribution(recorder.webhook_ms),
+        'webhook_cpu_ms': _distribution(recorder.webhook_cpu_ms),
+        'reply_time_to_send_seconds': _distribution(recorder.reply_seconds),
+        'replies_sent': replies,
+        'turns_unanswered': recorder.turns_unanswered,
+        'messaging_invocations': recorder.invocations,
+        'messaging_record_failures': recorder.invocation_failures,
+        'dead_lettered': env.sqs.depth(env.queue_urls['whatsapp-dlq']),
+        'dynamodb_calls': ddb_calls,
+        'dynamodb_calls_total': sum(ddb_calls.values()),
+        'dynamodb_calls_per_fragment': round(sum(ddb_calls.values()) / recorder.fragments_sent, 3) if recorder.fragments_sent else None,
+        'simulated_seconds': round(simulated_seconds, 3),
+        'messages_per_second_simulated': round(recorder.fragments_sent / simulated_seconds, 3) if simulated_seconds else None,
+        'wall_seconds': round(wall_seconds, 3),
+        'messages_per_second_wall': round(recorder.fragments_sent / wall_seconds, 3) if wall_seconds else None,
+    }
+
+
+# --- Comparison ---
+
+COMPARED_METRICS = [
+    ('webhook_latency_ms', 'p50'), ('webhook_latency_ms', 'p95'), ('webhook_latency_ms', 'p99'),
+    ('webhook_cpu_ms', 'p50'), ('webhook_cpu_ms', 'p95'),
+    ('reply_time_to_send_seconds', 'p50'), ('reply_time_to_send_seconds', 'p95'),
+    ('dynamodb_calls_per_fragment', None), ('messages_per_second_wall', None),
+]
+
+
+def compare(baseline, current):
+    """Returns {metric: {'baseline', 'current', 'change_pct'}} for the headline metrics of two reports."""
+    deltas = {}
+    for section, field in COMPARED_METRICS:
+        before = baseline.get(section)
+        after = current.get(section)
+        if field is not None:
+            before = (before or {}).get(field)
+            after = (after or {}).get(field)
+        name = f"{section}.{field}" if field else section
+        change = round((after - before) / before * 100.0, 2) if before and after is not None else None
+        deltas[name] = {'baseline': before, 'current': after, 'change_pct': change}
+    return deltas
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the staging + messaging Lambdas against offline fakes.")
+    parser.add_argument('--conversations', type=int, default=50)
+    parser.add_argument('--turns', type=int, default=3, help="User turns per conversation")
+    parser.add_argument('--ramp-seconds', type=float, default=60.0, help="Window over which conversations start")
+    parser.add_argument('--consumers', type=int, default=5, help="Concurrent messaging Lambda pollers")
+    parser.add_argument('--openai-run-seconds', type=float, default=DEFAULT_OPENAI_RUN_SECONDS)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="Write the JSON report here as well as to stdout")
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CURRENT'),
+                        help="Compare two saved reports instead of running")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as f_base, open(args.compare[1]) as f_current:
+            report = compare(json.load(f_base), json.load(f_current))
+    else:
+        report = run(args.conversations, args.turns, args.ramp_seconds, args.consumers, args.seed,
+                     args.openai_run_seconds)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=2)
+                f.write('\n')
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
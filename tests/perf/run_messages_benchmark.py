@@ -0,0 +1,147 @@
+"""
+Run Messages Benchmark
+
+Compares two ways of fetching a completed run's reply from its thread, on the
+offline OpenAI stand-in:
+
+    thread_scan   messages.list(thread_id, order='desc') with the default page
+                  size, then scan for the first assistant message of the run
+                  and take its first text block (the previous approach)
+    run_scoped    openai_service.list_run_messages: messages.list filtered by
+                  run_id, oldest first, following pagination; every text block
+                  of every message the run created is combined
+
+For threads of increasing length it reports the bytes the list calls return
+(the page objects serialised as JSON, as the API sends them), the number of
+calls, an estimated latency (--rtt per call + bytes / --bandwidth), and
+whether the reply that was extracted is complete when a run creates several
+messages.
+
+Usage:
+    python -m tests.perf.run_messages_benchmark
+    python -m tests.perf.run_messages_benchmark --history 10 50 200 --run-messages 3 --rtt 0.12
+"""
+
+import argparse
+import json
+import sys
+from types import SimpleNamespace
+
+from tests.fakes import FakeOpenAIBackend, VirtualClock
+from src.messaging_lambda.whatsapp.lambda_pkg.core import openai_service
+
+DEFAULT_HISTORY = (10, 50, 200)
+DEFAULT_RUN_MESSAGES = (1, 3)
+DEFAULT_RTT = 0.1                   # seconds per API call
+DEFAULT_BANDWIDTH = 2_000_000       # bytes per second
+MESSAGE_TEXT = "Thanks for your message. The role is hybrid, three days in the office, and the team is friendly. "
+
+
+def _plain(value):
+    """SimpleNamespace trees -> JSON-serialisable values."""
+    if isinstance(value, SimpleNamespace):
+        return {k: _plain(v) for k, v in vars(value).items()}
+    if isinstance(value, (list, tuple)):
+        return [_plain(v) for v in value]
+    return value
+
+
+class _MeasuredMessages:
+    """Wraps client.beta.threads.messages and counts list calls and the bytes they return."""
+
+    def __init__(self, messages):
+        self._messages = messages
+        self.calls = 0
+        self.bytes = 0
+
+    def list(self, **kwargs):
+        page = self._messages.list(**kwargs)
+        self.calls += 1
+        self.bytes += len(json.dumps({'object': 'list', 'data': _plain(page.data), 'first_id': page.first_id,
+                                      'last_id': page.last_id, 'has_more': page.has_more}))
+        return page
+
+    def __getattr__(self, name):
+        return getattr(self._messages, name)
+
+
+def thread_scan(client, thread_id, run_id):
+    """The previous retrieval: newest page of the thread, first text block of the run's message."""
+    for m in client.beta.threads.messages.list(thread_id=thread_id, order='desc').data:
+        if m.run_id == run_id and m.role == 'assistant':
+            return m.content[0].text.value if m.content and hasattr(m.content[0], 'text') else None
+    return None
+
+
+def run_scoped(client, thread_id, run_id):
+    """The current retrieval, as openai_service.process_reply_with_ai does it."""
+    texts = [t for t in (openai_service.message_text(m) for m in openai_service.list_run_messages(client, thread_id, run_id)) if t]
+    return openai_service.combine_reply_texts(texts) if texts else None
+
+
+def _scenario(history, run_messages):
+    """A thread with `history` earlier messages whose last run created `run_messages` messages."""
+    clock = VirtualClock()
+    backend = FakeOpenAIBackend(clock, run_latency=0)
+    client = backend.client()
+    for turn in range(history // 2):
+        backend.responder = lambda messages, assistant_id, turn=turn: json.dumps({'content': f"{turn}: {MESSAGE_TEXT}"})
+        client.beta.threads.messages.create(thread_id='thread_b', role='user', content=f"Question {turn}: {MESSAGE_TEXT}")
+        client.beta.threads.runs.create(thread_id='thread_b', assistant_id='asst_b')
+        clock.sleep(1)
+    reply = [json.dumps({'content': f"Part {n}: {MESSAGE_TEXT}"}) for n in range(run_messages)]
+    backend.responder = lambda messages, assistant_id: reply
+    client.beta.threads.messages.create(thread_id='thread_b', role='user', content='Last question')
+    run = client.beta.threads.runs.create(thread_id='thread_b', assistant_id='asst_b')
+    clock.sleep(1)
+    client.beta.threads.runs.retrieve(thread_id='thread_b', run_id=run.id)
+    expected = openai_service.combine_reply_texts(reply)
+    return client, run.id, expected
+
+
+def measure(history, run_messages, rtt=DEFAULT_RTT, bandwidth=DEFAULT_BANDWIDTH):
+    """Both approaches on one scenario."""
+    results = {}
+    for name, retrieve in (('thread_scan', thread_scan), ('run_scoped', run_scoped)):
+        client, run_id, expected = _scenario(history, run_messages)
+        measured = _MeasuredMessages(client.beta.threads.messages)
+        client.beta.threads.messages = measured
+        reply = retrieve(client, 'thread_b', run_id)
+        results[name] = {
+            'calls': measured.calls,
+            'bytes': measured.bytes,
+            'estimated_seconds': round(measured.calls * rtt + measured.bytes / bandwidth, 4),
+            'complete_reply': reply == expected,
+        }
+    results['bytes_saved_pct'] = round(100.0 * (1 - results['run_scoped']['bytes'] / results['thread_scan']['bytes']), 1)
+    return results
+
+
+def run(history=DEFAULT_HISTORY, run_messages=DEFAULT_RUN_MESSAGES, rtt=DEFAULT_RTT, bandwidth=DEFAULT_BANDWIDTH):
+    """Every history length x run message count; returns the report dict."""
+    return {
+        'rtt_seconds': rtt,
+        'bandwidth_bytes_per_second': bandwidth,
+        'scenarios': [dict(history_messages=h, run_messages=n, **measure(h, n, rtt, bandwidth))
+                      for h in history for n in run_messages],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare thread-scan and run-scoped retrieval of a run's reply.")
+    parser.add_argument('--history', type=int, nargs='+', default=list(DEFAULT_HISTORY),
+                        help="Earlier messages in the thread")
+    parser.add_argument('--run-messages', type=int, nargs='+', default=list(DEFAULT_RUN_MESSAGES),
+                        help="Messages created by the run")
+    parser.add_argument('--rtt', type=float, default=DEFAULT_RTT, help="Seconds per API call")
+    parser.add_argument('--bandwidth', type=float, default=DEFAULT_BANDWIDTH, help="Bytes per second")
+    args = parser.parse_args(argv)
+
+    report = run(args.history, args.run_messages, args.rtt, args.bandwidth)
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,16 @@
+from tests.perf import ai_backend_comparison as comparison
+
+
+def test_chat_completions_needs_fewer_calls_and_replies_sooner():
+    report = comparison.run(turns=3, generation_seconds=2.0, call_latency=0.1)
+    threads, chat = report['backends']['threads'], report['backends']['chat_completions']
+    assert threads['replies'] == chat['replies'] == 3
+    assert chat['openai_calls'] == {'openai.assistants.retrieve': 1, 'openai.chat.completions.create': 3}
+    assert threads['openai_calls_per_reply'] > chat['openai_calls_per_reply']
+    assert chat['mean_reply_seconds'] < threads['mean_reply_seconds']
+    assert report['reply_speedup'] > 1
+
+
+def test_main_prints_report(capsys):
+    assert comparison.main(['--turns', '1', '--generation-seconds', '0.5']) == 0
+    assert '"reply_speedup"' in capsys.readouterr().out
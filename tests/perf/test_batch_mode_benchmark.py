@@ -0,0 +1,18 @@
+from tests.perf import batch_mode_benchmark as benchmark
+
+
+def test_batch_mode_doubles_replies_per_dollar_with_fewer_api_calls():
+    report = benchmark.run(conversations=12, requests_per_minute=60, batch_seconds=300, runner_interval=60)
+    interactive, batch = report['modes']['interactive'], report['modes']['batch']
+    assert interactive['replies'] == batch['replies'] == 12
+    assert batch['prompt_tokens'] == interactive['prompt_tokens']
+    assert batch['openai_calls_by_operation']['openai.batches.create'] == 1
+    assert 'openai.chat.completions.create' not in batch['openai_calls_by_operation']
+    assert batch['openai_calls'] < interactive['openai_calls']
+    assert report['replies_per_dollar_ratio'] == 2.0
+    assert batch['mean_reply_seconds'] >= 300 > interactive['mean_reply_seconds']
+
+
+def test_main_prints_report(capsys):
+    assert benchmark.main(['--conversations', '2', '--mode', 'batch', '--batch-seconds', '60']) == 0
+    assert '"replies_per_dollar"' in capsys.readouterr().out
@@ -0,0 +1,25 @@
+import os
+
+from tests.perf import batch_window_simulator as sim
+
+SAMPLE = os.path.join(os.path.dirname(__file__), 'data', 'fragment_timings_sample.jsonl')
+
+
+def test_single_fragment_batches_flush_on_fixed_window():
+    fragments = [{'t': 0.0, 'body': 'hello,'}, {'t': 120.0, 'body': 'ok'}]
+    result = sim.simulate_conversation(fragments, sim.fixed_policy(10))
+    assert [b['latency_seconds'] for b in result['batches']] == [10.0, 10.0]
+    assert result['rejected'] == 0
+
+
+def test_fragment_during_processing_is_rejected():
+    fragments = [{'t': 0.0, 'body': 'hi'}, {'t': 12.0, 'body': 'are you there'}]
+    result = sim.simulate_conversation(fragments, sim.fixed_policy(10), processing_seconds=8)
+    assert len(result['batches']) == 1
+    assert result['rejected'] == 1
+
+
+def test_sample_report_adaptive_not_slower_than_fixed():
+    report = sim.run(sim.load_recordings(SAMPLE), fixed_window=10)
+    assert report['fixed']['batches'] > 0
+    assert report['adaptive']['latency_mean_seconds'] <= report['fixed']['latency_mean_seconds']
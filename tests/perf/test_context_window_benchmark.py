@@ -0,0 +1,21 @@
+from tests.perf import context_window_benchmark as bench
+
+
+def test_managed_strategies_keep_prompt_and_latency_flat():
+    report = bench.run(turns=40, budget=1500, keep=6)
+    none, truncate, summarize = (report['strategies'][s] for s in ('none', 'truncate', 'summarize'))
+
+    assert none['prompt_tokens_growth'] > 1.5
+    assert none['reply_seconds_late'] > none['reply_seconds_middle']
+    for managed in (truncate, summarize):
+        assert managed['prompt_tokens_growth'] <= 1.1
+        assert managed['reply_seconds_late'] < none['reply_seconds_late']
+        assert managed['prompt_tokens_late'] < 1500
+    assert truncate['context_window'] == {'strategy': 'truncate', 'covers': 0}
+    assert summarize['summary_calls'] > 0 and summarize['context_window']['covers'] > 0
+
+
+def test_main_prints_report(capsys):
+    assert bench.main(['--turns', '6', '--budget', '200', '--keep', '2', '--strategy', 'summarize',
+                       '--backend', 'chat_completions']) == 0
+    assert '"prompt_tokens_at_turn"' in capsys.readouterr().out
@@ -0,0 +1,15 @@
+from tests.perf import dynamodb_microbenchmark as bench
+
+
+def test_both_paths_return_the_same_values():
+    report = bench.run(iterations=20, message_count=3)
+    assert set(report['operations']) == {'get_item', 'query', 'put_item', 'update_item'}
+    for operation, result in report['operations'].items():
+        assert result['same_result'], operation
+        assert result['resource_us_per_call'] > 0
+        assert result['lowlevel_us_per_call'] > 0
+
+
+def test_main_prints_report(capsys):
+    assert bench.main(['--iterations', '5', '--messages', '1']) == 0
+    assert '"speedup"' in capsys.readouterr().out
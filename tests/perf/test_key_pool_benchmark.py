@@ -0,0 +1,17 @@
+from tests.perf import key_pool_benchmark as benchmark
+
+
+def test_pool_stays_under_the_limits_that_round_robin_bounces_off():
+    report = benchmark.run(replies=60, arrival_rate=3.0, keys=2, requests_per_minute=120, workers=8,
+                           modes=('round_robin', 'pool'))
+    round_robin, pool = report['modes']['round_robin'], report['modes']['pool']
+    assert round_robin['replies'] == pool['replies'] == 60
+    assert round_robin['rate_limited_responses'] > 0
+    assert pool['rate_limited_responses'] < round_robin['rate_limited_responses']
+    assert pool['redeliveries'] < round_robin['redeliveries']
+    assert pool['mean_reply_seconds'] < round_robin['mean_reply_seconds']
+
+
+def test_main_prints_report(capsys):
+    assert benchmark.main(['--replies', '5', '--arrival-rate', '1', '--mode', 'pool']) == 0
+    assert '"rate_limited_responses"' in capsys.readouterr().out
@@ -0,0 +1,46 @@
+import json
+
+from twilio.request_validator import RequestValidator
+from urllib.parse import parse_qsl
+
+from tests.fakes import FakeEnvironment
+from tests.perf import load_generator as lg
+
+
+def test_workload_is_reproducible_and_shaped():
+    plans = lg.build_workload(conversations=30, turns=2, ramp_seconds=60, seed=3)
+    assert plans == lg.build_workload(conversations=30, turns=2, ramp_seconds=60, seed=3)
+    assert all(0 <= p['start'] <= 60 and len(p['turns']) == 2 for p in plans)
+    fragments = [len(t['fragments']) for p in plans for t in p['turns']]
+    assert min(fragments) >= 1 and max(fragments) <= 5
+    assert all(t['fragments'][0][0] == 0.0 for p in plans for t in p['turns'])
+
+
+def test_generated_webhooks_pass_twilio_validation():
+    environment = FakeEnvironment()
+    seeded = environment.seed_conversation()
+    event = environment.webhook_event(seeded, 'hello')
+    url = f"https://{event['headers']['Host']}/{event['requestContext']['stage']}{event['path']}"
+    params = dict(parse_qsl(event['body']))
+    assert RequestValidator(seeded['auth_token']).validate(url, params, event['headers']['X-Twilio-Signature'])
+
+
+def test_small_run_reports_every_turn_answered():
+    report = lg.run(conversations=4, turns=2, ramp_seconds=10, consumers=2, seed=5)
+    assert report['fragments_sent'] == sum(report['webhook_outcomes'].values())
+    assert report['webhook_outcomes'].get('error', 0) == 0
+    assert report['turns_unanswered'] == 0
+    assert report['reply_time_to_send_seconds']['count'] == 8
+    assert report['reply_time_to_send_seconds']['p50'] > 0
+    assert report['dynamodb_calls_total'] == sum(report['dynamodb_calls'].values()) > 0
+    assert report['dead_lettered'] == 0
+    json.dumps(report)
+
+
+def test_compare_reports_percentage_change():
+    baseline = {'webhook_latency_ms': {'p50': 50.0}, 'dynamodb_calls_per_fragment': 8.0}
+    current = {'webhook_latency_ms': {'p50': 40.0}, 'dynamodb_calls_per_fragment': 6.0}
+    deltas = lg.compare(baseline, current)
+    assert deltas['webhook_latency_ms.p50']['change_pct'] == -20.0
+    assert deltas['dynamodb_calls_per_fragment']['change_pct'] == -25.0
+    assert deltas['webhook_latency_ms.p99']['change_pct'] is None
@@ -0,0 +1,18 @@
+from tests.perf import run_messages_benchmark as benchmark
+
+
+def test_run_scoped_retrieval_returns_fewer_bytes_and_the_whole_reply():
+    report = benchmark.run(history=(30,), run_messages=(1, 3))
+    single, several = report['scenarios']
+    for scenario in (single, several):
+        assert scenario['run_scoped']['calls'] == scenario['thread_scan']['calls'] == 1
+        assert scenario['run_scoped']['bytes'] < scenario['thread_scan']['bytes']
+        assert scenario['run_scoped']['estimated_seconds'] < scenario['thread_scan']['estimated_seconds']
+        assert scenario['run_scoped']['complete_reply']
+    assert single['thread_scan']['complete_reply']
+    assert not several['thread_scan']['complete_reply']
+
+
+def test_main_prints_report(capsys):
+    assert benchmark.main(['--history', '4', '--run-messages', '2']) == 0
+    assert '"bytes_saved_pct"' in capsys.readouterr().out
@@ -0,0 +1,49 @@
+import pytest
+from unittest.mock import patch, sentinel
+
+from src.messaging_lambda.whatsapp.lambda_pkg.core import ai_backend
+
+# --- Test Cases ---
+
+@pytest.mark.parametrize('ai_config, default, expected', [
+    (None, 'threads', 'threads'),
+    ({}, 'chat_completions', 'chat_completions'),
+    ({'backend': 'chat_completions'}, 'threads', 'chat_completions'),
+    ({'backend': 'responses'}, 'threads', 'threads'),
+    ({'backend': 'responses'}, 'bogus', 'threads'),
+])
+def test_backend_for(ai_config, default, expected):
+    with patch.object(ai_backend, 'AI_BACKEND_DEFAULT', default):
+        assert ai_backend.backend_for(ai_config) == expected
+
+def test_only_chat_completions_needs_history():
+    assert ai_backend.needs_history('chat_completions')
+    assert not ai_backend.needs_history('threads')
+
+def test_threads_backend_polls_or_streams():
+    with patch.object(ai_backend.openai_service, 'process_reply_with_ai', return_value=sentinel.polled) as poll, \
+         patch.object(ai_backend.openai_service, 'stream_reply_with_ai', return_value=sentinel.streamed) as stream:
+        assert ai_backend.generate_reply('threads', 'th', 'asst', 'hi', 'sk', history=[{}]) is sentinel.polled
+        assert ai_backend.generate_reply('threads', 'th', 'asst', 'hi', 'sk', on_text=print) is sentinel.streamed
+    poll.assert_called_once_with('th', 'asst', 'hi', 'sk', run_options=None)
+    stream.assert_called_once_with('th', 'asst', 'hi', 'sk', print, run_options=None)
+
+def test_chat_completions_backend_gets_history_not_thread():
+    history = [{'role': 'user', 'content': 'earlier'}]
+    with patch.object(ai_backend.chat_completions_service, 'process_reply_with_chat', return_value=sentinel.reply) as chat:
+        assert ai_backend.generate_reply('chat_completions', None, 'asst', 'hi', 'sk', history=history) is sentinel.reply
+    chat.assert_called_once_with('asst', 'hi', 'sk', history=history, on_text=None, additional_instructions=None)
+
+def test_window_becomes_run_options_or_history_slice():
+    window = {'active': True, 'strategy': 'summarize', 'keep': 1, 'summary': 'Earlier: asked about pay.',
+              'covers': 2, 'max_prompt_tokens': 100}
+    history = [{'role': 'user', 'content': str(n)} for n in range(5)]
+    with patch.object(ai_backend.openai_service, 'process_reply_with_ai') as poll, \
+         patch.object(ai_backend.chat_completions_service, 'process_reply_with_chat') as chat:
+        ai_backend.generate_reply('threads', 'th', 'asst', 'hi', 'sk', window=window)
+        ai_backend.generate_reply('chat_completions', None, 'asst', 'hi', 'sk', history=history, window=window)
+    run_options = poll.call_args.kwargs['run_options']
+    assert run_options['truncation_strategy'] == {'type': 'last_messages', 'last_messages': 3}
+    assert 'Earlier: asked about pay.' in run_options['additional_instructions']
+    assert chat.call_args.kwargs['history'] == history[3:]
+    assert chat.call_args.kwargs['additional_instructions'] == run_options['additional_instructions']
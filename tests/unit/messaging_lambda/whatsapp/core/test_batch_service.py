@@ -0,0 +1,92 @@
+import pytest
+import json
+from types import SimpleNamespace
+from unittest.mock import patch, MagicMock
+
+from src.messaging_lambda.whatsapp.lambda_pkg.core import batch_service
+from src.messaging_lambda.whatsapp.lambda_pkg.core.openai_service import (
+    AI_SUCCESS, AI_TRANSIENT_ERROR, AI_NON_TRANSIENT_ERROR, AI_INVALID_INPUT
+)
+
+# --- Helpers & Fixtures ---
+
+def result_line(custom_id, status_code=200, content='{"content": "Hi"}', error=None):
+    body = {'choices': [{'message': {'content': content}}], 'usage': {'prompt_tokens': 12, 'completion_tokens': 3, 'total_tokens': 15}}
+    if status_code != 200:
+        body = {'error': {'message': error or 'Server error'}}
+    return json.dumps({'id': 'batch_req_1', 'custom_id': custom_id, 'response': {'status_code': status_code, 'body': body}, 'error': None})
+
+@pytest.fixture
+def client():
+    mock = MagicMock()
+    with patch.object(batch_service.key_pool, 'client', return_value=mock):
+        yield mock
+
+# --- Test Cases ---
+
+@pytest.mark.parametrize('ai_config, backend, reprocess, expected', [
+    ({}, 'chat_completions', True, False),
+    ({'batch_mode': 'always'}, 'chat_completions', False, True),
+    ({'batch_mode': 'reprocess'}, 'chat_completions', False, False),
+    ({'batch_mode': 'reprocess'}, 'chat_completions', True, True),
+    ({'batch_mode': 'always'}, 'threads', False, False),
+    ({'batch_mode': 'sometimes'}, 'chat_completions', False, False),
+])
+def test_use_batch(ai_config, backend, reprocess, expected):
+    assert batch_service.use_batch(ai_config, backend, reprocess) is expected
+
+def test_build_request_applies_context_window(client):
+    window = {'active': True, 'keep_last_messages': 1, 'summary': 'Earlier: salary.', 'covers': 0}
+    with patch.object(batch_service.chat_completions_service, 'build_request', return_value={'model': 'm'}) as build, \
+         patch.object(batch_service.context_window, 'recent_history', return_value=['recent']), \
+         patch.object(batch_service.context_window, 'summary_instructions', return_value='summary') as summary:
+        status, body = batch_service.build_request('asst_1', 'Is it remote?', 'sk-a', history=['old', 'recent'], window=window)
+    assert (status, body) == (AI_SUCCESS, {'model': 'm'})
+    build.assert_called_once_with(client, 'asst_1', 'Is it remote?', ['recent'], 'summary')
+    summary.assert_called_once_with(window)
+
+def test_build_request_requires_inputs():
+    assert batch_service.build_request('asst_1', '', 'sk-a')[0] == AI_INVALID_INPUT
+
+def test_submit_uploads_jsonl_and_creates_batch(client):
+    client.files.create.return_value = SimpleNamespace(id='file_1')
+    client.batches.create.return_value = SimpleNamespace(id='batch_1')
+    requests = [{'custom_id': 'c1', 'body': {'model': 'm', 'messages': []}}]
+
+    status, result = batch_service.submit('sk-a', requests, metadata={'model': 'm'})
+
+    assert (status, result) == (AI_SUCCESS, {'batch_id': 'batch_1', 'input_file_id': 'file_1', 'requests': 1})
+    name, content = client.files.create.call_args.kwargs['file']
+    assert json.loads(content.read()) == {'custom_id': 'c1', 'method': 'POST', 'url': '/v1/chat/completions',
+                                          'body': {'model': 'm', 'messages': []}}
+    client.batches.create.assert_called_once_with(input_file_id='file_1', endpoint='/v1/chat/completions',
+                                                  completion_window='24h', metadata={'model': 'm'})
+
+def test_parse_results_maps_lines_to_ai_statuses():
+    text = '\n'.join([result_line('ok'), result_line('limited', 429), result_line('bad', 400), 'not json', ''])
+    results = batch_service.parse_results(text)
+    assert results['ok'] == (AI_SUCCESS, {'response_content': '{"content": "Hi"}', 'prompt_tokens': 12,
+                                          'completion_tokens': 3, 'total_tokens': 15})
+    assert results['limited'][0] == AI_TRANSIENT_ERROR
+    assert results['bad'][0] == AI_NON_TRANSIENT_ERROR
+    assert len(results) == 3
+
+def test_poll_reads_output_and_error_files_once_ended(client):
+    client.batches.retrieve.return_value = SimpleNamespace(status='completed', output_file_id='file_out', error_file_id='file_err')
+    files = {'file_out': result_line('a'), 'file_err': result_line('b', 500)}
+    client.files.content.side_effect = lambda file_id: SimpleNamespace(text=files[file_id])
+
+    status, polled = batch_service.poll('sk-a', 'batch_1')
+
+    assert status == AI_SUCCESS and polled['state'] == batch_service.BATCH_ENDED
+    assert polled['results']['a'][0] == AI_SUCCESS and polled['results']['b'][0] == AI_TRANSIENT_ERROR
+
+def test_poll_in_progress_batch_reads_no_files(client):
+    client.batches.retrieve.return_value = SimpleNamespace(status='in_progress')
+    assert batch_service.poll('sk-a', 'batch_1') == (AI_SUCCESS, {'state': batch_service.BATCH_IN_PROGRESS,
+                                                                 'status': 'in_progress', 'results': {}})
+    client.files.content.assert_not_called()
+
+def test_missing_result_is_transient_unless_the_batch_failed():
+    assert batch_service.missing_result('expired', 'c1')[0] == AI_TRANSIENT_ERROR
+    assert batch_service.missing_result('failed', 'c1')[0] == AI_NON_TRANSIENT_ERROR
@@ -0,0 +1,133 @@
+import pytest
+import json
+import openai
+import httpx
+from types import SimpleNamespace
+from unittest.mock import patch, MagicMock
+
+from src.messaging_lambda.whatsapp.lambda_pkg.core import chat_completions_service as chat
+from src.messaging_lambda.whatsapp.lambda_pkg.core.openai_service import (
+    AI_SUCCESS, AI_TRANSIENT_ERROR, AI_NON_TRANSIENT_ERROR, AI_INVALID_INPUT
+)
+
+# --- Helpers & Fixtures ---
+
+HISTORY = [
+    {'role': 'user', 'content': 'Hi'},
+    {'role': 'assistant', 'content': 'Hello! How can I help?', 'prompt_tokens': 10},
+    {'role': 'system', 'content': 'ignored'},
+    {'role': 'user', 'content': ''},
+]
+
+def usage(prompt=20, completion=5):
+    return SimpleNamespace(prompt_tokens=prompt, completion_tokens=completion, total_tokens=prompt + completion)
+
+def assistant(**overrides):
+    settings = dict(model='gpt-4o', instructions='Be brief.', temperature=None, top_p=None, response_format='auto')
+    settings.update(overrides)
+    return SimpleNamespace(**settings)
+
+def completion(content):
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))], usage=usage())
+
+def chunk(text=None, chunk_usage=None):
+    choices = [SimpleNamespace(delta=SimpleNamespace(content=text))] if text is not None else []
+    return SimpleNamespace(choices=choices, usage=chunk_usage)
+
+class FakeStream(list):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+@pytest.fixture
+def client():
+    mock = MagicMock()
+    mock.beta.assistants.retrieve.return_value = assistant()
+    with patch.object(chat, '_assistant_cache', {}), \
+         patch.object(chat.openai, 'OpenAI', return_value=mock):
+        yield mock
+
+# --- Test Cases ---
+
+def test_build_messages_wraps_assistant_history_and_skips_other_entries():
+    messages = chat.build_messages('Be brief.', HISTORY, 'Is it remote?')
+    assert messages == [
+        {'role': 'system', 'content': 'Be brief.'},
+        {'role': 'user', 'content': 'Hi'},
+        {'role': 'assistant', 'content': json.dumps({'content': 'Hello! How can I help?'})},
+        {'role': 'user', 'content': 'Is it remote?'},
+    ]
+
+@pytest.mark.parametrize('max_history, expected_roles', [
+    (0, ['system', 'user']),
+    (2, ['system', 'user']),     # the last two entries are skipped ones
+    (3, ['system', 'assistant', 'user']),
+])
+def test_build_messages_keeps_only_recent_history(max_history, expected_roles):
+    messages = chat.build_messages('Be brief.', HISTORY, 'Next', max_history=max_history)
+    assert [m['role'] for m in messages] == expected_roles
+
+def test_assistant_settings_are_cached_until_ttl(client):
+    clock = MagicMock()
+    clock.time.side_effect = [1000, 1100, 1000 + chat.ASSISTANT_CACHE_TTL_SECONDS]
+    with patch.object(chat, 'time', clock):
+        for _ in range(3):
+            settings = chat.get_assistant_settings(client, 'asst_1')
+    assert client.beta.assistants.retrieve.call_count == 2
+    assert settings['model'] == 'gpt-4o' and settings['response_format'] is None
+
+def test_reply_is_one_completion_with_assistant_settings(client):
+    client.beta.assistants.retrieve.return_value = assistant(temperature=0.3, response_format=SimpleNamespace(type='json_object'))
+    client.chat.completions.create.return_value = completion('{"content": "Yes"}')
+
+    status, result = chat.process_reply_with_chat('asst_1', 'Is it remote?', 'sk', history=HISTORY)
+
+    assert status == AI_SUCCESS
+    assert result == {'response_content': '{"content": "Yes"}', 'prompt_tokens': 20,
+                      'completion_tokens': 5, 'total_tokens': 25}
+    kwargs = client.chat.completions.create.call_args.kwargs
+    assert kwargs['model'] == 'gpt-4o'
+    assert kwargs['temperature'] == 0.3 and 'top_p' not in kwargs
+    assert kwargs['response_format'] == {'type': 'json_object'}
+    assert kwargs['messages'][-1] == {'role': 'user', 'content': 'Is it remote?'}
+
+def test_streamed_reply_calls_on_text_and_reads_usage_chunk(client):
+    client.chat.completions.create.return_value = FakeStream(
+        [chunk('{"content": '), chunk(''), chunk('"Yes"}'), chunk(chunk_usage=usage(30, 4))])
+    received = []
+
+    status, result = chat.process_reply_with_chat('asst_1', 'Q', 'sk', on_text=received.append)
+
+    assert status == AI_SUCCESS
+    assert received == ['{"content": ', '"Yes"}']
+    assert result['response_content'] == '{"content": "Yes"}' and result['total_tokens'] == 34
+    kwargs = client.chat.completions.create.call_args.kwargs
+    assert kwargs['stream'] is True and kwargs['stream_options'] == {'include_usage': True}
+
+def test_failing_on_text_does_not_fail_the_reply(client):
+    client.chat.completions.create.return_value = FakeStream([chunk('a'), chunk('b')])
+    on_text = MagicMock(side_effect=RuntimeError('send failed'))
+    status, result = chat.process_reply_with_chat('asst_1', 'Q', 'sk', on_text=on_text)
+    assert status == AI_SUCCESS and result['response_content'] == 'ab'
+    on_text.assert_called_once_with('a')
+
+@pytest.mark.parametrize('error_class, status_code, expected', [
+    (openai.RateLimitError, 429, AI_TRANSIENT_ERROR),
+    (openai.InternalServerError, 500, AI_TRANSIENT_ERROR),
+    (openai.BadRequestError, 400, AI_NON_TRANSIENT_ERROR),
+])
+def test_api_errors_map_to_statuses(client, error_class, status_code, expected):
+    response = httpx.Response(status_code, request=httpx.Request('POST', 'https://api.openai.com/v1/chat/completions'))
+    client.chat.completions.create.side_effect = error_class('boom', response=response, body=None)
+    status, result = chat.process_reply_with_chat('asst_1', 'Q', 'sk')
+    assert status == expected and 'error_message' in result
+
+def test_empty_completion_is_non_transient(client):
+    client.chat.completions.create.return_value = completion('')
+    assert chat.process_reply_with_chat('asst_1', 'Q', 'sk')[0] == AI_NON_TRANSIENT_ERROR
+
+def test_missing_arguments_are_invalid_input(client):
+    assert chat.process_reply_with_chat('asst_1', '', 'sk')[0] == AI_INVALID_INPUT
+    client.chat.completions.create.assert_not_called()
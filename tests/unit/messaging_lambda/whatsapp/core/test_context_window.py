@@ -0,0 +1,85 @@
+import pytest
+from types import SimpleNamespace
+from unittest.mock import patch, MagicMock
+
+from src.messaging_lambda.whatsapp.lambda_pkg.core import context_window
+
+# --- Helpers & Fixtures ---
+
+def history(count):
+    return [{'role': 'user' if n % 2 == 0 else 'assistant', 'content': f"m{n}"} for n in range(count)]
+
+def window(**overrides):
+    settings = {'max_prompt_tokens': 1000, 'strategy': 'summarize', 'keep_last_messages': 4}
+    state = overrides.pop('state', None)
+    settings.update(overrides)
+    item = {'context_window': state} if state is not None else {}
+    return context_window.plan({'context_window': settings}, item)
+
+# --- Test Cases ---
+
+def test_plan_uses_defaults_without_project_settings():
+    with patch.object(context_window, 'CONTEXT_MAX_PROMPT_TOKENS', 0), \
+         patch.object(context_window, 'CONTEXT_KEEP_LAST_MESSAGES', 10):
+        plan = context_window.plan({}, {})
+    assert plan == {'max_prompt_tokens': 0, 'strategy': 'truncate', 'keep': 10,
+                    'active': False, 'summary': None, 'covers': 0}
+
+def test_plan_reads_stored_state_and_falls_back_on_unknown_strategy():
+    plan = window(strategy='compress', state={'strategy': 'truncate', 'covers': 6})
+    assert plan['strategy'] == 'truncate'
+    assert plan['active'] and plan['covers'] == 6
+
+def test_inactive_window_changes_nothing():
+    plan = window()
+    assert context_window.run_options(plan) == {}
+    assert context_window.recent_history(plan, history(30)) == history(30)
+    assert context_window.summary_instructions(plan) is None
+
+def test_truncate_keeps_last_messages():
+    plan = window(strategy='truncate', state={'strategy': 'truncate', 'covers': 0})
+    assert context_window.run_options(plan) == {'truncation_strategy': {'type': 'last_messages', 'last_messages': 5}}
+    assert context_window.recent_history(plan, history(30)) == history(30)[-4:]
+
+def test_summarize_uses_summary_and_entries_after_it():
+    plan = window(state={'strategy': 'summarize', 'covers': 20, 'summary': 'Candidate is Ana.'})
+    options = context_window.run_options(plan)
+    assert options['truncation_strategy'] == {'type': 'last_messages', 'last_messages': 9}
+    assert options['additional_instructions'].endswith('Candidate is Ana.')
+    assert context_window.recent_history(plan, history(26)) == history(26)[20:]
+
+@pytest.mark.parametrize('prompt_tokens, state, max_tokens, expected', [
+    (999, None, 1000, None),
+    (1000, None, 1000, {'strategy': 'summarize', 'covers': 0}),
+    (5000, None, 0, None),
+    (5000, {'strategy': 'summarize', 'covers': 0}, 1000, None),
+])
+def test_activation(prompt_tokens, state, max_tokens, expected):
+    assert context_window.activation(window(max_prompt_tokens=max_tokens, state=state), prompt_tokens) == expected
+
+def test_compaction_waits_for_twice_keep_entries():
+    plan = window(state={'strategy': 'summarize', 'covers': 10, 'summary': 's'})
+    assert not context_window.needs_compaction(plan, 17)
+    assert context_window.needs_compaction(plan, 18)
+    assert not context_window.needs_compaction(window(strategy='truncate', state={'covers': 0}), 100)
+
+def test_compact_folds_older_entries_into_summary():
+    plan = window(state={'strategy': 'summarize', 'covers': 2, 'summary': 'Old summary.'})
+    client = MagicMock()
+    client.chat.completions.create.return_value = SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(content=' New summary. '))])
+    with patch.object(context_window.key_pool.openai, 'OpenAI', return_value=client):
+        state = context_window.compact(plan, history(12), 'sk')
+
+    assert state == {'strategy': 'summarize', 'covers': 8, 'summary': 'New summary.'}
+    kwargs = client.chat.completions.create.call_args.kwargs
+    prompt = kwargs['messages'][1]['content']
+    assert prompt.startswith('Current summary:\nOld summary.')
+    assert 'user: m2' in prompt and 'assistant: m7' in prompt and 'm8' not in prompt
+    assert kwargs['max_tokens'] == context_window.CONTEXT_SUMMARY_MAX_TOKENS
+
+def test_compact_failure_returns_none():
+    client = MagicMock()
+    client.chat.completions.create.side_effect = RuntimeError('down')
+    with patch.object(context_window.key_pool.openai, 'OpenAI', return_value=client):
+        assert context_window.compact(window(state={'covers': 0}), history(12), 'sk') is None
@@ -0,0 +1,147 @@
+import pytest
+from unittest.mock import patch, MagicMock
+
+from src.messaging_lambda.whatsapp.lambda_pkg.core import key_pool
+
+# --- Helpers & Fixtures ---
+
+class FakeTime:
+    def __init__(self, now=1000.0):
+        self.now = now
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+@pytest.fixture
+def clock():
+    fake_time = FakeTime()
+    with patch.object(key_pool, 'time', fake_time), \
+         patch.object(key_pool, '_keys', {}), \
+         patch.object(key_pool, '_http_clients', {}), \
+         patch.object(key_pool, 'KEY_POOL_ENABLED', True), \
+         patch.object(key_pool, 'KEY_POOL_INITIAL_CONCURRENCY', 4.0), \
+         patch.object(key_pool, 'KEY_POOL_MAX_WAIT_SECONDS', 5.0), \
+         patch.object(key_pool, 'metrics', MagicMock()):
+        yield fake_time
+
+# --- Test Cases ---
+
+def test_api_keys_combines_single_key_and_pool_without_duplicates():
+    assert key_pool.api_keys({'ai_api_key': 'sk-a'}) == ['sk-a']
+    assert key_pool.api_keys({'ai_api_key': 'sk-a', 'ai_api_keys': ['sk-b', 'sk-a', '', None]}) == ['sk-a', 'sk-b']
+    assert key_pool.api_keys({'ai_api_keys': 'sk-c'}) == ['sk-c']
+    assert key_pool.api_keys(None) == []
+
+@pytest.mark.parametrize('value, seconds', [
+    ('1s', 1.0), ('6m0s', 360.0), ('20ms', 0.02), ('1h2m3.5s', 3723.5), ('0s', 0.0),
+])
+def test_parse_duration(value, seconds):
+    assert key_pool.parse_duration(value) == pytest.approx(seconds)
+
+def test_parse_duration_ignores_missing_or_invalid_values():
+    assert key_pool.parse_duration(None) is None
+    assert key_pool.parse_duration('soon') is None
+
+def test_rate_limited_response_blocks_key_and_halves_limit(clock):
+    key_pool.observe('sk-a', 429, {'retry-after-ms': '2500'})
+    state = key_pool.key_state('sk-a')
+    assert state['blocked_until'] == 1002.5
+    assert state['limit'] == 2.0
+
+    key_pool.observe('sk-a', 429, {'retry-after': '3'})     # same congestion event: no second decrease
+    assert key_pool.key_state('sk-a')['limit'] == 2.0
+    assert key_pool.key_state('sk-a')['blocked_until'] == 1003.0
+
+def test_rate_limited_response_without_headers_uses_default_backoff(clock):
+    with patch.object(key_pool, 'KEY_POOL_DEFAULT_BACKOFF_SECONDS', 4.0):
+        key_pool.observe('sk-a', 429, {})
+    assert key_pool.key_state('sk-a')['blocked_until'] == 1004.0
+
+def test_exhausted_remaining_requests_blocks_until_reset(clock):
+    key_pool.observe('sk-a', 200, {'x-ratelimit-remaining-requests': '0', 'x-ratelimit-reset-requests': '1.5s',
+                                   'x-ratelimit-remaining-tokens': '900', 'x-ratelimit-reset-tokens': '40ms'})
+    state = key_pool.key_state('sk-a')
+    assert state['blocked_until'] == 1001.5
+    assert state['remaining_requests'] == 0 and state['remaining_tokens'] == 900
+
+def test_limit_grows_only_while_the_key_is_used_up_to_it(clock):
+    key_pool.observe('sk-a', 200, {'x-ratelimit-remaining-requests': '50'})
+    assert key_pool.key_state('sk-a')['limit'] == 4.0         # idle key: no increase
+    key_pool._keys['sk-a']['in_flight'] = 4
+    key_pool.observe('sk-a', 200, {'x-ratelimit-remaining-requests': '50'})
+    assert key_pool.key_state('sk-a')['limit'] == 4.25
+
+def test_remaining_requests_below_in_flight_decreases_limit(clock):
+    key_pool._state('sk-a')['in_flight'] = 3
+    key_pool.observe('sk-a', 200, {'x-ratelimit-remaining-requests': '2'})
+    assert key_pool.key_state('sk-a')['limit'] == 2.0
+
+def test_lease_spreads_calls_over_keys_and_releases(clock):
+    keys = ['sk-a', 'sk-b']
+    with key_pool.lease(keys) as first:
+        with key_pool.lease(keys) as second:
+            assert {first, second} == set(keys)
+            assert key_pool.key_state(first)['in_flight'] == 1
+    assert key_pool.key_state('sk-a')['in_flight'] == key_pool.key_state('sk-b')['in_flight'] == 0
+
+def test_lease_skips_blocked_key_and_prefers_more_remaining_requests(clock):
+    key_pool.observe('sk-a', 429, {'retry-after': '30'})
+    with key_pool.lease(['sk-a', 'sk-b']) as api_key:
+        assert api_key == 'sk-b'
+    key_pool.observe('sk-c', 200, {'x-ratelimit-remaining-requests': '10'})
+    key_pool.observe('sk-d', 200, {'x-ratelimit-remaining-requests': '90'})
+    with key_pool.lease(['sk-c', 'sk-d']) as api_key:
+        assert api_key == 'sk-d'
+
+def test_lease_waits_for_a_key_to_unblock(clock):
+    key_pool.observe('sk-a', 429, {'retry-after': '2'})
+    with key_pool.lease(['sk-a']) as api_key:
+        assert api_key == 'sk-a'
+    assert clock.now >= 1002.0
+    assert max(clock.sleeps) <= key_pool.KEY_POOL_POLL_SECONDS
+
+def test_lease_waits_for_concurrency_then_gives_up(clock):
+    key_pool._state('sk-a')['limit'] = 1.0
+    with key_pool.lease(['sk-a']) as first:
+        with key_pool.lease(['sk-a']) as second:
+            assert first == 'sk-a' and second is None
+    assert clock.now == pytest.approx(1005.0)
+    key_pool.metrics.put_metric.assert_any_call('openai_key_exhausted', 1, key_pool.metrics.UNIT_COUNT)
+
+def test_disabled_pool_uses_first_key_without_tracking(clock):
+    with patch.object(key_pool, 'KEY_POOL_ENABLED', False):
+        with key_pool.lease(['sk-a', 'sk-b']) as api_key:
+            assert api_key == 'sk-a'
+        key_pool.observe('sk-a', 429, {'retry-after': '30'})
+    assert key_pool._keys == {}
+
+def test_client_reports_responses_to_the_pool(clock):
+    with patch.object(key_pool.openai, 'OpenAI') as openai_client:
+        key_pool.client('sk-a')
+        key_pool.client('sk-a')
+    http_client = openai_client.call_args.kwargs['http_client']
+    assert openai_client.call_args_list[0].kwargs['http_client'] is http_client    # one client per key
+    hook = http_client.event_hooks['response'][0]
+    hook(MagicMock(status_code=429, headers={'retry-after': '7'}))
+    assert key_pool.key_state('sk-a')['blocked_until'] == 1007.0
+
+def test_remaining_requests_down_to_in_flight_holds_one_request_share(clock):
+    key_pool._state('sk-a')['in_flight'] = 2
+    key_pool.observe('sk-a', 200, {'x-ratelimit-remaining-requests': '2', 'x-ratelimit-limit-requests': '240',
+                                   'x-ratelimit-reset-requests': '60s'})
+    assert key_pool.key_state('sk-a')['blocked_until'] == pytest.approx(1000.25)
+
+def test_pace_releases_waiting_requests_one_interval_apart(clock):
+    key_pool.observe('sk-a', 200, {'x-ratelimit-remaining-requests': '0', 'x-ratelimit-limit-requests': '60',
+                                   'x-ratelimit-reset-requests': '60s'})
+    clock.sleep = clock.sleeps.append                       # three requests arriving together
+    for _ in range(3):
+        key_pool.pace('sk-a')
+    assert clock.sleeps == pytest.approx([1.0, 2.0, 3.0])
+    key_pool.pace('sk-b')                                   # unblocked key: no wait
+    assert len(clock.sleeps) == 3
@@ -0,0 +1,47 @@
+import pytest
+import json
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+from src.messaging_lambda.whatsapp.lambda_pkg.core import openai_service
+
+# --- Helpers & Fixtures ---
+
+def text_block(value):
+    return SimpleNamespace(type='text', text=SimpleNamespace(value=value, annotations=[]))
+
+def message(message_id, *blocks, role='assistant', run_id='run_1'):
+    return SimpleNamespace(id=message_id, role=role, run_id=run_id, content=list(blocks))
+
+def page(data, has_more=False):
+    return SimpleNamespace(data=data, has_more=has_more)
+
+# --- Test Cases ---
+
+def test_message_text_joins_text_blocks_and_skips_others():
+    image = SimpleNamespace(type='image_file', image_file=SimpleNamespace(file_id='f'))
+    assert openai_service.message_text(message('m', text_block('{"content": "Hel'), image, text_block('lo"}'))) == '{"content": "Hello"}'
+    assert openai_service.message_text(message('m', image)) is None
+
+@pytest.mark.parametrize('texts, expected', [
+    (['{"content": "One"}'], '{"content": "One"}'),
+    (['{"content": "One"}', '{"content": "Two"}'], json.dumps({'content': 'One\n\nTwo'})),
+    (['{"content": "One"}', 'plain'], '{"content": "One"}\n\nplain'),
+])
+def test_combine_reply_texts(texts, expected):
+    assert openai_service.combine_reply_texts(texts) == expected
+
+def test_list_run_messages_filters_by_run_and_follows_pages():
+    client = MagicMock()
+    client.beta.threads.messages.list.side_effect = [
+        page([message('m1', text_block('a')), message('m2', text_block('b'), role='user')], has_more=True),
+        page([message('m3', text_block('c'))]),
+    ]
+
+    messages = openai_service.list_run_messages(client, 'thread_1', 'run_1')
+
+    assert [m.id for m in messages] == ['m1', 'm3']
+    first, second = client.beta.threads.messages.list.call_args_list
+    assert first.kwargs == {'thread_id': 'thread_1', 'run_id': 'run_1', 'order': 'asc',
+                            'limit': openai_service.RUN_MESSAGES_PAGE_LIMIT}
+    assert second.kwargs['after'] == 'm2'
@@ -0,0 +1,98 @@
+import pytest
+import json
+from unittest.mock import patch
+
+from src.messaging_lambda.whatsapp.lambda_pkg.core import progressive_reply
+from src.messaging_lambda.whatsapp.lambda_pkg.core.progressive_reply import ContentFieldDecoder, ProgressiveReply
+
+# --- Helpers & Fixtures ---
+
+def fragments(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+def recording_sender(fail_on=None):
+    """send(body) that records bodies and returns Twilio-shaped payloads; fails the call numbered fail_on."""
+    sent = []
+
+    def send(body):
+        if fail_on is not None and len(sent) + 1 == fail_on:
+            sent.append(None)
+            return 'TRANSIENT_ERROR', {'error_message': 'boom'}
+        sent.append(body)
+        return 'SUCCESS', {'message_sid': f"SM{len(sent)}", 'body': body}
+    return send, sent
+
+# --- Test Cases ---
+
+@pytest.mark.parametrize('size', [1, 2, 3, 7, 1000])
+def test_decoder_matches_json_loads_for_any_split(size):
+    content = 'Line one.\nTab\there "quoted" \\ back é \U0001F600 done'
+    raw = json.dumps({'content': content, 'other': 'x'})
+    decoder = ContentFieldDecoder()
+    decoded = ''.join(decoder.feed(piece) for piece in fragments(raw, size))
+    assert decoded == content
+    assert decoder.done
+
+def test_decoder_ignores_text_without_content_field():
+    decoder = ContentFieldDecoder()
+    assert decoder.feed('plain text reply. Not JSON.') == ''
+    assert not decoder.done
+
+@pytest.mark.parametrize('flag, default, expected', [
+    (None, False, False),
+    (None, True, True),
+    (True, False, True),
+    ('true', False, True),
+    (False, True, False),
+])
+def test_is_enabled(flag, default, expected):
+    ai_config = {} if flag is None else {'progressive_replies': flag}
+    with patch.object(progressive_reply, 'PROGRESSIVE_REPLIES_ENABLED', default):
+        assert progressive_reply.is_enabled(ai_config) is expected
+
+def test_sentences_are_sent_once_long_enough_and_rest_is_left():
+    content = "Hi! Thanks for getting in touch about the role. It is still open. Do you have a CV you can share?"
+    send, sent = recording_sender()
+    reply = ProgressiveReply(send, min_part_chars=40)
+    for piece in fragments(json.dumps({'content': content}), 5):
+        reply.feed(piece)
+
+    # "It is still open. " alone is under the minimum, and the last sentence has no boundary yet
+    assert sent == ["Hi! Thanks for getting in touch about the role."]
+    assert reply.remainder(content) == "It is still open. Do you have a CV you can share?"
+    assert [p['message_sid'] for p in reply.parts] == ['SM1']
+
+def test_paragraph_breaks_always_end_a_part():
+    content = "Short.\n\nSecond paragraph here.\n\nLast"
+    send, sent = recording_sender()
+    reply = ProgressiveReply(send, min_part_chars=500)
+    reply.feed(json.dumps({'content': content}))
+    assert sent == ['Short.', 'Second paragraph here.']
+    assert reply.remainder(content) == 'Last'
+
+def test_long_text_without_boundary_is_cut_at_a_space():
+    content = ('word ' * 30) + 'end'
+    send, sent = recording_sender()
+    reply = ProgressiveReply(send, min_part_chars=10, max_part_chars=32)
+    reply.feed(json.dumps({'content': content}))
+    assert all(len(body) <= 32 for body in sent)
+    assert ' '.join(sent + [reply.remainder(content)]).split() == content.split()
+
+def test_failed_send_stops_parts_and_keeps_its_text_for_the_remainder():
+    content = "First sentence is here. Second sentence is here. Third sentence is here. Tail"
+    send, sent = recording_sender(fail_on=2)
+    reply = ProgressiveReply(send, min_part_chars=10)
+    for piece in fragments(json.dumps({'content': content}), 3):
+        reply.feed(piece)
+
+    assert sent == ['First sentence is here.', None]
+    assert reply.error == ('TRANSIENT_ERROR', {'error_message': 'boom'})
+    assert reply.remainder(content) == "Second sentence is here. Third sentence is here. Tail"
+
+def test_first_part_latency_metric_is_recorded():
+    send, _ = recording_sender()
+    with patch.object(progressive_reply.metrics, 'put_metric') as put_metric:
+        reply = ProgressiveReply(send, min_part_chars=1)
+        reply.feed('{"content": "One. Two. ')
+    put_metric.assert_called_once()
+    assert put_metric.call_args.args[0] == 'reply_first_part'
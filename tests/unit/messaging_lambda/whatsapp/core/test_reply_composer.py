@@ -0,0 +1,50 @@
+import pytest
+from unittest.mock import patch
+
+from src.messaging_lambda.whatsapp.lambda_pkg.core import reply_composer
+
+# --- Test Cases ---
+
+def test_short_reply_is_one_part():
+    assert reply_composer.compose('  Hello there.  ') == ['Hello there.']
+    assert reply_composer.compose('') == []
+
+def test_split_prefers_paragraph_breaks():
+    text = 'First paragraph. Still first.\n\nSecond paragraph here.\n\nThird.'
+    assert reply_composer.split(text, 40) == ['First paragraph. Still first.', 'Second paragraph here.\n\nThird.']
+
+def test_split_falls_back_to_sentences_then_spaces():
+    text = 'One sentence here. Two sentence here! Three is a much longer sentence without an end'
+    parts = reply_composer.split(text, 40)
+    assert parts == ['One sentence here. Two sentence here!', 'Three is a much longer sentence without', 'an end']
+    assert all(len(part) <= 40 for part in parts)
+
+def test_split_hard_cuts_words_longer_than_the_limit():
+    assert reply_composer.split('x' * 25, 10) == ['x' * 10, 'x' * 10, 'x' * 5]
+
+@pytest.mark.parametrize('limit', [50, 160, 1600])
+def test_split_keeps_every_word_in_order(limit):
+    text = ' '.join(f"Sentence {n} has a few words." + ('\n\n' if n % 7 == 0 else '') for n in range(300))
+    parts = reply_composer.split(text, limit)
+    assert all(len(part) <= limit for part in parts)
+    assert ' '.join(parts).split() == text.split()
+
+def test_whatsapp_limit_respects_company_max_message_length():
+    assert reply_composer.part_limit('whatsapp') == reply_composer.WHATSAPP_MAX_PART_CHARS
+    assert reply_composer.part_limit('whatsapp', {'max_message_length': 500}) == 500
+    assert reply_composer.part_limit('whatsapp', {'max_message_length': 'bad'}) == reply_composer.WHATSAPP_MAX_PART_CHARS
+
+def test_sms_limit_depends_on_encoding_and_segments():
+    with patch.object(reply_composer, 'SMS_MAX_SEGMENTS', 3):
+        assert reply_composer.part_limit('sms', text='short') == 160
+        assert reply_composer.part_limit('sms', text='a' * 200) == 3 * 153
+        assert reply_composer.part_limit('sms', text='a' * 200 + '€') == 3 * 153 - 1
+        assert reply_composer.part_limit('sms', text='Привет ' * 20) == 3 * 67
+
+def test_remainder_skips_the_parts_already_sent():
+    text = 'First part.\n\nSecond part. Third part.'
+    assert reply_composer.remainder(text, ['First part.']) == 'Second part. Third part.'
+    assert reply_composer.remainder(text, ['First part.', 'Second part. Third part.']) == ''
+    assert reply_composer.remainder(text, []) == text
+    # A different reply than the one partly sent - the rest after the matching parts goes out
+    assert reply_composer.remainder(text, ['First part.', 'Something else']) == 'Second part. Third part.'
@@ -0,0 +1,116 @@
+import pytest
+import threading
+from unittest.mock import MagicMock, patch
+
+from src.messaging_lambda.whatsapp.lambda_pkg.core import sender_rate_limiter
+from src.messaging_lambda.whatsapp.lambda_pkg.utils import retry_policy
+
+NOW = 1700000000.0
+SENDER = '+46700000000'
+
+# --- Helpers & Fixtures ---
+
+class StepClock:
+    """time.time / monotonic / sleep on one virtual timeline."""
+    def __init__(self, start=NOW):
+        self.now = start
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+class SharedCounter:
+    """reserve_send_tokens over an in-memory counter per key."""
+    def __init__(self):
+        self.counts = {}
+        self.calls = []
+
+    def __call__(self, counter_key, amount, limit, expires_at):
+        self.calls.append((counter_key, amount, limit, expires_at))
+        if self.counts.get(counter_key, 0) + amount > limit:
+            return {'status': 'LIMIT_EXCEEDED'}
+        self.counts[counter_key] = self.counts.get(counter_key, 0) + amount
+        return {'status': 'RESERVED', 'count': self.counts[counter_key]}
+
+@pytest.fixture(autouse=True)
+def clean_state():
+    sender_rate_limiter.reset_local_state()
+    with patch.object(retry_policy, '_state', threading.local()):
+        yield
+    sender_rate_limiter.reset_local_state()
+
+@pytest.fixture
+def clock():
+    clock = StepClock()
+    with patch.object(sender_rate_limiter, 'time', clock):
+        yield clock
+
+# --- Test Cases ---
+
+def test_resolve_limit_falls_back_to_default():
+    assert sender_rate_limiter.resolve_limit({'sender_messages_per_second': '20'}) == 20
+    assert sender_rate_limiter.resolve_limit(None) == sender_rate_limiter.DEFAULT_SENDER_MESSAGES_PER_SECOND
+    with patch.object(sender_rate_limiter, 'DEFAULT_SENDER_MESSAGES_PER_SECOND', 80):
+        assert sender_rate_limiter.resolve_limit({'sender_messages_per_second': 'bad'}) == 80
+
+def test_no_limit_skips_the_counter(clock):
+    reserve = MagicMock()
+    assert sender_rate_limiter.acquire(SENDER, 0, reserve) is True
+    reserve.assert_not_called()
+
+def test_lease_is_spent_locally(clock):
+    """One round trip reserves a lease for the current second; the rest needs no DynamoDB call."""
+    counter = SharedCounter()
+    for _ in range(5):
+        assert sender_rate_limiter.acquire(SENDER, 80, counter) is True
+    assert counter.calls == [(f"sendrate#{SENDER}#{int(NOW)}", 5, 80, int(NOW) + 1 + 300)]
+
+def test_full_second_waits_for_the_next_one(clock):
+    counter = SharedCounter()
+    sends = []
+    for _ in range(3):
+        assert sender_rate_limiter.acquire(SENDER, 2, counter) is True
+        sends.append(clock.now)
+    assert sends == [NOW, NOW, NOW + 1]
+
+def test_wait_metric_only_when_the_send_waited(clock):
+    counter = SharedCounter()
+    with patch.object(sender_rate_limiter.metrics, 'put_metric') as mock_metric:
+        for _ in range(3):
+            sender_rate_limiter.acquire(SENDER, 2, counter)
+    assert mock_metric.call_args_list == [(('sender_rate_wait', 1000.0),)]
+
+def test_containers_share_the_sender_limit(clock):
+    """Another container's reservations count against the same second."""
+    counter = SharedCounter()
+    counter.counts[f"sendrate#{SENDER}#{int(NOW)}"] = 10
+    assert sender_rate_limiter.acquire(SENDER, 10, counter) is True
+    assert clock.now == NOW + 1
+
+def test_wait_is_capped_by_budget_and_deadline(clock):
+    counter = SharedCounter()
+    counter.counts[f"sendrate#{SENDER}#{int(NOW)}"] = 1
+    with patch.object(sender_rate_limiter, 'SENDER_RATE_MAX_WAIT_SECONDS', 0.5):
+        assert sender_rate_limiter.acquire(SENDER, 1, counter) is False
+    with patch.object(retry_policy, 'remaining_seconds', return_value=0.2):
+        assert sender_rate_limiter.acquire(SENDER, 1, counter) is False
+    assert clock.slept == []
+
+def test_throttled_sender_backs_off(clock):
+    counter = SharedCounter()
+    assert sender_rate_limiter.acquire(SENDER, 80, counter) is True
+    assert sender_rate_limiter.acquire(SENDER, 80, counter, throttled=True) is True
+    assert clock.slept == [sender_rate_limiter.SENDER_THROTTLE_BACKOFF_SECONDS]
+    assert len(counter.calls) == 2 # the leftover lease was dropped
+
+def test_counter_errors_fail_open(clock):
+    reserve = MagicMock(return_value={'status': 'DB_ERROR'})
+    assert sender_rate_limiter.acquire(SENDER, 1, reserve) is True
+    assert clock.slept == []
@@ -0,0 +1,79 @@
+import pytest
+from unittest.mock import patch, MagicMock
+from botocore.exceptions import ClientError
+
+# Use the correct absolute import path based on project structure
+from src.messaging_lambda.whatsapp.lambda_pkg.services import company_config_service
+
+NOW = 1700000000.0
+RECORD = {
+    'company_id': 'ci-aaa-000',
+    'project_id': 'pi-aaa-000',
+    'updated_at': '2025-01-01T00:00:00+00:00',
+    'rate_limits': {'concurrent_conversations': 5},
+    'ai_config': {'openai_config': {'whatsapp': {'api_key_reference': 'openai-ref'}}},
+    'channel_config': {'whatsapp': {'whatsapp_credentials_id': 'twilio-ref'}},
+}
+
+# --- Fixtures ---
+
+@pytest.fixture
+def mock_table():
+    table = MagicMock()
+    table.get_item.return_value = {'Item': dict(RECORD)}
+    with patch.object(company_config_service, 'company_data_table', table), \
+         patch.object(company_config_service, '_cache', {}):
+        yield table
+
+@pytest.fixture
+def mock_time():
+    with patch('src.messaging_lambda.whatsapp.lambda_pkg.services.company_config_service.time.time', return_value=NOW) as mock:
+        yield mock
+
+# --- Test Cases ---
+
+def test_disabled_without_table():
+    with patch.object(company_config_service, 'company_data_table', None):
+        assert company_config_service.is_enabled() is False
+        assert company_config_service.get_company_config('ci-aaa-000', 'pi-aaa-000') == (company_config_service.CONFIG_DISABLED, None)
+
+def test_record_is_cached_and_revalidated_by_updated_at(mock_table, mock_time):
+    assert company_config_service.get_company_config('ci-aaa-000', 'pi-aaa-000') == (company_config_service.CONFIG_FOUND, RECORD)
+    company_config_service.get_company_config('ci-aaa-000', 'pi-aaa-000')
+    assert mock_table.get_item.call_count == 1
+
+    # No config_version on the record - updated_at is the version stamp
+    mock_table.get_item.return_value = {'Item': {'updated_at': RECORD['updated_at']}}
+    mock_time.return_value = NOW + company_config_service.COMPANY_CONFIG_CACHE_TTL_SECONDS
+    status, record = company_config_service.get_company_config('ci-aaa-000', 'pi-aaa-000')
+    assert (status, record) == (company_config_service.CONFIG_FOUND, RECORD)
+    assert mock_table.get_item.call_count == 2
+
+def test_changed_stamp_reloads_record(mock_table, mock_time):
+    company_config_service.get_company_config('ci-aaa-000', 'pi-aaa-000')
+    updated = dict(RECORD, updated_at='2025-02-01T00:00:00+00:00', rate_limits={'concurrent_conversations': 1})
+    mock_table.get_item.side_effect = [{'Item': {'updated_at': updated['updated_at']}}, {'Item': updated}]
+    mock_time.return_value = NOW + company_config_service.COMPANY_CONFIG_CACHE_TTL_SECONDS
+    _, record = company_config_service.get_company_config('ci-aaa-000', 'pi-aaa-000')
+    assert record['rate_limits'] == {'concurrent_conversations': 1}
+
+def test_changed_updated_at_reloads_record_with_same_config_version(mock_table, mock_time):
+    mock_table.get_item.return_value = {'Item': dict(RECORD, config_version=1)}
+    company_config_service.get_company_config('ci-aaa-000', 'pi-aaa-000')
+    updated = dict(RECORD, config_version=1, updated_at='2025-02-01T00:00:00+00:00', rate_limits={'concurrent_conversations': 1})
+    mock_table.get_item.side_effect = [{'Item': {'config_version': 1, 'updated_at': updated['updated_at']}}, {'Item': updated}]
+    mock_time.return_value = NOW + company_config_service.COMPANY_CONFIG_CACHE_TTL_SECONDS
+    _, record = company_config_service.get_company_config('ci-aaa-000', 'pi-aaa-000')
+    assert record['rate_limits'] == {'concurrent_conversations': 1}
+
+def test_db_error(mock_table, mock_time):
+    mock_table.get_item.side_effect = ClientError({'Error': {'Code': 'AccessDeniedException', 'Message': 'Test'}}, 'GetItem')
+    assert company_config_service.get_company_config('ci-aaa-000', 'pi-aaa-000') == (company_config_service.CONFIG_DB_ERROR, None)
+
+def test_channel_view_flattens_channel_maps():
+    view = company_config_service.channel_view(RECORD, 'whatsapp')
+    assert view == {
+        'rate_limits': {'concurrent_conversations': 5},
+        'ai_config': {'api_key_reference': 'openai-ref'},
+        'channel_config': {'whatsapp_credentials_id': 'twilio-ref'},
+    }
@@ -2,7 +2,7 @@ import pytest
 import os
 from unittest.mock import patch, MagicMock, ANY, call
 from botocore.exceptions import ClientError
-import boto3 # Required for boto3.dynamodb.conditions.Key
+from boto3.dynamodb.types import TypeDeserializer
 
 # Use the correct absolute import path based on project structure
 from src.messaging_lambda.whatsapp.lambda_pkg.services import dynamodb_service
@@ -12,7 +12,12 @@ CONVERSATIONS_TABLE_NAME = 'ai-multi-comms-conversations-dev'
 STAGE_TABLE_NAME = 'conversations-stage-test'
 LOCK_TABLE_NAME = 'conversations-trigger-lock-test'
 
-# --- Fixtures ---
+# --- Helpers & Fixtures ---
+
+def unmarshal(attribute_values):
+    """Wire-format attribute values -> Python, as boto3 would return them."""
+    deserializer = TypeDeserializer()
+    return {k: deserializer.deserialize(v) for k, v in attribute_values.items()}
 
 @pytest.fixture
 def mock_dynamodb_resource():
@@ -34,15 +39,21 @@ def mock_dynamodb_resource():
             raise ValueError(f"Unexpected table name: {table_name}")
 
     mock_resource.Table.side_effect = table_side_effect
+    # Per-request calls go through the plain low-level client (services/dynamodb_lowlevel.py)
+    mock_client = MagicMock(name="DynamoDBClient")
+    mock_conversations_table.name = CONVERSATIONS_TABLE_NAME
+    mock_stage_table.name = STAGE_TABLE_NAME
+    mock_lock_table.name = LOCK_TABLE_NAME
 
-    # Patch environment variables AND boto3.resource
+    # Patch environment variables AND aws_clients.resource
     # Patching environment variables is needed if table names are read dynamically
     with patch.dict(os.environ, {
         'CONVERSATIONS_TABLE': CONVERSATIONS_TABLE_NAME,
         'CONVERSATIONS_STAGE_TABLE': STAGE_TABLE_NAME,
         'CONVERSATIONS_TRIGGER_LOCK_TABLE': LOCK_TABLE_NAME
         }, clear=True), \
-         patch('src.messaging_lambda.whatsapp.lambda_pkg.services.dynamodb_service.boto3.resource') as mock_boto_resource:
+         patch('src.messaging_lambda.whatsapp.lambda_pkg.services.dynamodb_service.aws_clients.resource') as mock_boto_resource, \
+         patch('src.messaging_lambda.whatsapp.lambda_pkg.services.dynamodb_service.aws_clients.client', return_value=mock_client):
 
         mock_boto_resource.return_value = mock_resource
 
@@ -55,7 +66,8 @@ def mock_dynamodb_resource():
         yield {
             "conversations": mock_conversations_table,
             "stage": mock_stage_table,
-            "lock": mock_lock_table
+            "lock": mock_lock_table,
+            "client": mock_client
         }
 
         # Reload again after tests to restore original state if needed
@@ -66,23 +78,24 @@ def mock_dynamodb_resource():
 
 def test_acquire_processing_lock_success(mock_dynamodb_resource):
     """Test successful acquisition of the processing lock."""
-    mock_conv_table = mock_dynamodb_resource['conversations']
+    mock_client = mock_dynamodb_resource['client']
     pk = "user1"
     sk = "conv1"
     result = dynamodb_service.acquire_processing_lock(pk, sk)
 
     assert result == dynamodb_service.LOCK_ACQUIRED
-    mock_conv_table.update_item.assert_called_once_with(
-        Key={'primary_channel': pk, 'conversation_id': sk},
+    mock_client.update_item.assert_called_once_with(
+        TableName=CONVERSATIONS_TABLE_NAME,
+        Key={'primary_channel': {'S': pk}, 'conversation_id': {'S': sk}},
         UpdateExpression="SET conversation_status = :proc_status",
         ConditionExpression="attribute_not_exists(conversation_status) OR conversation_status <> :proc_status",
-        ExpressionAttributeValues={':proc_status': dynamodb_service.PROCESSING_STATUS}
+        ExpressionAttributeValues={':proc_status': {'S': dynamodb_service.PROCESSING_STATUS}}
     )
 
 def test_acquire_processing_lock_exists(mock_dynamodb_resource):
     """Test when lock exists (ConditionalCheckFailedException)."""
-    mock_conv_table = mock_dynamodb_resource['conversations']
-    mock_conv_table.update_item.side_effect = ClientError(
+    mock_client = mock_dynamodb_resource['client']
+    mock_client.update_item.side_effect = ClientError(
         error_response={'Error': {'Code': 'ConditionalCheckFailedException'}},
         operation_name='UpdateItem'
     )
@@ -91,8 +104,8 @@ def test_acquire_processing_lock_exists(mock_dynamodb_resource):
 
 def test_acquire_processing_lock_db_error(mock_dynamodb_resource):
     """Test other DynamoDB errors during lock acquisition."""
-    mock_conv_table = mock_dynamodb_resource['conversations']
-    mock_conv_table.update_item.side_effect = ClientError(
+    mock_client = mock_dynamodb_resource['client']
+    mock_client.update_item.side_effect = ClientError(
         error_response={'Error': {'Code': 'ProvisionedThroughputExceededException'}},
         operation_name='UpdateItem'
     )
@@ -101,8 +114,8 @@ def test_acquire_processing_lock_db_error(mock_dynamodb_resource):
 
 def test_acquire_processing_lock_unexpected_error(mock_dynamodb_resource):
     """Test unexpected errors during lock acquisition."""
-    mock_conv_table = mock_dynamodb_resource['conversations']
-    mock_conv_table.update_item.side_effect = Exception("Oops")
+    mock_client = mock_dynamodb_resource['client']
+    mock_client.update_item.side_effect = Exception("Oops")
     result = dynamodb_service.acquire_processing_lock("u1", "c1")
     assert result == dynamodb_service.DB_ERROR
 
@@ -110,43 +123,43 @@ def test_acquire_processing_lock_unexpected_error(mock_dynamodb_resource):
 
 def test_query_staging_table_success(mock_dynamodb_resource):
     """Test successful query of staging table."""
-    mock_stage_table = mock_dynamodb_resource['stage']
-    expected_items = [{"message_sid": "s1", "body": "b1"}, {"message_sid": "s2", "body": "b2"}]
-    mock_stage_table.query.return_value = {'Items': expected_items}
+    mock_client = mock_dynamodb_resource['client']
+    mock_client.query.return_value = {'Items': [
+        {"message_sid": {"S": "s1"}, "body": {"S": "b1"}, "received_at_ms": {"N": "1700000000000"}},
+        {"message_sid": {"S": "s2"}, "body": {"S": "b2"}}
+    ]}
 
     items = dynamodb_service.query_staging_table("conv1")
 
-    assert items == expected_items
-    mock_stage_table.query.assert_called_once_with(
-        KeyConditionExpression=ANY, # Rely on ANY matcher
+    assert items == [
+        {"message_sid": "s1", "body": "b1", "received_at_ms": 1700000000000},
+        {"message_sid": "s2", "body": "b2"}
+    ]
+    mock_client.query.assert_called_once_with(
+        TableName=STAGE_TABLE_NAME,
+        KeyConditionExpression="conversation_id = :cid",
+        ExpressionAttributeValues={':cid': {'S': 'conv1'}},
         ConsistentRead=True
     )
-    # Removed detailed check of KeyConditionExpression attributes
-    # # Check KeyConditionExpression content more specifically
-    # args, kwargs = mock_stage_table.query.call_args
-    # key_expr = kwargs['KeyConditionExpression']
-    # assert key_expr.expression_operator == '='
-    # assert key_expr.name == 'conversation_id'
-    # assert key_expr.values == ['conv1']
 
 def test_query_staging_table_no_items(mock_dynamodb_resource):
     """Test query when no items are found."""
-    mock_stage_table = mock_dynamodb_resource['stage']
-    mock_stage_table.query.return_value = {'Items': []}
+    mock_client = mock_dynamodb_resource['client']
+    mock_client.query.return_value = {'Items': []}
     items = dynamodb_service.query_staging_table("conv1")
     assert items == []
 
 def test_query_staging_table_db_error(mock_dynamodb_resource):
     """Test ClientError during staging query."""
-    mock_stage_table = mock_dynamodb_resource['stage']
-    mock_stage_table.query.side_effect = ClientError({'Error': {'Code': 'InternalServerError'}}, 'Query')
+    mock_client = mock_dynamodb_resource['client']
+    mock_client.query.side_effect = ClientError({'Error': {'Code': 'InternalServerError'}}, 'Query')
     items = dynamodb_service.query_staging_table("conv1")
     assert items is None
 
 def test_query_staging_table_unexpected_error(mock_dynamodb_resource):
     """Test unexpected error during staging query."""
-    mock_stage_table = mock_dynamodb_resource['stage']
-    mock_stage_table.query.side_effect = Exception("Oops")
+    mock_client = mock_dynamodb_resource['client']
+    mock_client.query.side_effect = Exception("Oops")
     items = dynamodb_service.query_staging_table("conv1")
     assert items is None
 
@@ -154,29 +167,29 @@ def test_query_staging_table_unexpected_error(mock_dynamodb_resource):
 
 def test_get_conversation_item_success(mock_dynamodb_resource):
     """Test successful retrieval of conversation item."""
-    mock_conv_table = mock_dynamodb_resource['conversations']
-    expected_item = {"pk": "user1", "sk": "conv1", "status": "active"}
-    mock_conv_table.get_item.return_value = {'Item': expected_item}
+    mock_client = mock_dynamodb_resource['client']
+    mock_client.get_item.return_value = {'Item': {"pk": {"S": "user1"}, "sk": {"S": "conv1"}, "status": {"S": "active"}}}
 
     item = dynamodb_service.get_conversation_item("user1", "conv1")
 
-    assert item == expected_item
-    mock_conv_table.get_item.assert_called_once_with(
-        Key={'primary_channel': "user1", 'conversation_id': "conv1"},
+    assert item == {"pk": "user1", "sk": "conv1", "status": "active"}
+    mock_client.get_item.assert_called_once_with(
+        TableName=CONVERSATIONS_TABLE_NAME,
+        Key={'primary_channel': {'S': "user1"}, 'conversation_id': {'S': "conv1"}},
         ConsistentRead=True
     )
 
 def test_get_conversation_item_not_found(mock_dynamodb_resource):
     """Test get_item when item is not found."""
-    mock_conv_table = mock_dynamodb_resource['conversations']
-    mock_conv_table.get_item.return_value = {'ResponseMetadata': {}} # No 'Item' key
+    mock_client = mock_dynamodb_resource['client']
+    mock_client.get_item.return_value = {'ResponseMetadata': {}} # No 'Item' key
     item = dynamodb_service.get_conversation_item("user1", "conv1")
     assert item is None
 
 def test_get_conversation_item_db_error(mock_dynamodb_resource):
     """Test ClientError during get_item."""
-    mock_conv_table = mock_dynamodb_resource['conversations']
-    mock_conv_table.get_item.side_effect = ClientError({'Error': {'Code': 'ThrottlingException'}}, 'GetItem')
+    mock_client = mock_dynamodb_resource['client']
+    mock_client.get_item.side_effect = ClientError({'Error': {'Code': 'ThrottlingException'}}, 'GetItem')
     item = dynamodb_service.get_conversation_item("user1", "conv1")
     assert item is None
 
@@ -185,7 +198,7 @@ def test_get_conversation_item_db_error(mock_dynamodb_resource):
 @patch('src.messaging_lambda.whatsapp.lambda_pkg.services.dynamodb_service.datetime')
 def test_update_conversation_success_minimal(mock_dt, mock_dynamodb_resource):
     """Test successful minimal update after reply."""
-    mock_conv_table = mock_dynamodb_resource['conversations']
+    mock_client = mock_dynamodb_resource['client']
     mock_now = MagicMock()
     mock_now.isoformat.return_value = "2023-01-01T12:00:00+00:00"
     mock_dt.now.return_value = mock_now
@@ -199,14 +212,17 @@ def test_update_conversation_success_minimal(mock_dt, mock_dynamodb_resource):
 
     assert status == dynamodb_service.DB_SUCCESS
     assert msg is None
-    mock_conv_table.update_item.assert_called_once()
-    call_args = mock_conv_table.update_item.call_args[1]
-    assert call_args['Key'] == {'primary_channel': pk, 'conversation_id': sk}
+    mock_client.update_item.assert_called_once()
+    call_args = mock_client.update_item.call_args[1]
+    values = unmarshal(call_args['ExpressionAttributeValues'])
+    assert call_args['TableName'] == CONVERSATIONS_TABLE_NAME
+    assert call_args['Key'] == {'primary_channel': {'S': pk}, 'conversation_id': {'S': sk}}
     assert call_args['ConditionExpression'] == "#status = :lock_status"
-    assert call_args['ExpressionAttributeValues'][':new_status'] == "reply_sent"
-    assert call_args['ExpressionAttributeValues'][':ts'] == "2023-01-01T12:00:00+00:00"
-    assert call_args['ExpressionAttributeValues'][':new_msgs'] == [user_msg, assist_msg]
-    assert call_args['ExpressionAttributeValues'][':lock_status'] == dynamodb_service.PROCESSING_STATUS
+    assert call_args['UpdateExpression'] == "SET #status = :new_status, #updated = :ts, #msgs = list_append(if_not_exists(#msgs, :empty_list), :new_msgs)"
+    assert values[':new_status'] == "reply_sent"
+    assert values[':ts'] == "2023-01-01T12:00:00+00:00"
+    assert values[':new_msgs'] == [user_msg, assist_msg]
+    assert values[':lock_status'] == dynamodb_service.PROCESSING_STATUS
     assert call_args['ExpressionAttributeNames']['#status'] == "conversation_status"
     assert call_args['ExpressionAttributeNames']['#updated'] == "updated_at"
     assert call_args['ExpressionAttributeNames']['#msgs'] == "messages"
@@ -214,7 +230,7 @@ def test_update_conversation_success_minimal(mock_dt, mock_dynamodb_resource):
 @patch('src.messaging_lambda.whatsapp.lambda_pkg.services.dynamodb_service.datetime')
 def test_update_conversation_success_all_fields(mock_dt, mock_dynamodb_resource):
     """Test successful update with all optional fields."""
-    mock_conv_table = mock_dynamodb_resource['conversations']
+    mock_client = mock_dynamodb_resource['client']
     mock_now = MagicMock()
     mock_now.isoformat.return_value = "2023-01-01T12:00:00+00:00"
     mock_dt.now.return_value = mock_now
@@ -232,14 +248,17 @@ def test_update_conversation_success_all_fields(mock_dt, mock_dynamodb_resource)
     )
 
     assert status == dynamodb_service.DB_SUCCESS
-    mock_conv_table.update_item.assert_called_once()
-    call_args = mock_conv_table.update_item.call_args[1]
-    assert call_args['ExpressionAttributeValues'][':new_status'] == "handoff_pending"
-    assert call_args['ExpressionAttributeValues'][':proc_time'] == 1234
-    assert call_args['ExpressionAttributeValues'][':task_comp'] == 1
-    assert call_args['ExpressionAttributeValues'][':handoff'] is True
-    assert call_args['ExpressionAttributeValues'][':handoff_reason'] == "AI confused"
-    assert call_args['ExpressionAttributeValues'][':tid'] == "thread_new"
+    mock_client.update_item.assert_called_once()
+    call_args = mock_client.update_item.call_args[1]
+    values = unmarshal(call_args['ExpressionAttributeValues'])
+    assert values[':new_status'] == "handoff_pending"
+    assert values[':proc_time'] == 1234
+    assert values[':task_comp'] == 1
+    assert values[':handoff'] is True
+    assert values[':handoff_reason'] == "AI confused"
+    assert values[':tid'] == "thread_new"
+    for name in ("#tid", "#proc_time", "#task_comp", "#handoff", "#handoff_reason"):
+        assert name in call_args['UpdateExpression']
     assert "#proc_time" in call_args['ExpressionAttributeNames']
     assert "#task_comp" in call_args['ExpressionAttributeNames']
     assert "#handoff" in call_args['ExpressionAttributeNames']
@@ -248,8 +267,8 @@ def test_update_conversation_success_all_fields(mock_dt, mock_dynamodb_resource)
 
 def test_update_conversation_lock_lost(mock_dynamodb_resource):
     """Test ConditionalCheckFailedException during final update."""
-    mock_conv_table = mock_dynamodb_resource['conversations']
-    mock_conv_table.update_item.side_effect = ClientError(
+    mock_client = mock_dynamodb_resource['client']
+    mock_client.update_item.side_effect = ClientError(
         error_response={'Error': {'Code': 'ConditionalCheckFailedException'}},
         operation_name='UpdateItem'
     )
@@ -257,10 +276,35 @@ def test_update_conversation_lock_lost(mock_dynamodb_resource):
     assert status == dynamodb_service.DB_LOCK_LOST
     assert "ConditionalCheckFailedException" in msg
 
+def test_update_conversation_skips_history_of_reply_already_stored(mock_dynamodb_resource):
+    """A reply whose user message is already stored only releases the lock."""
+    mock_client = mock_dynamodb_resource['client']
+    mock_client.update_item.side_effect = [_conditional_check_failed(), {}]
+
+    status, msg = dynamodb_service.update_conversation_after_reply("u", "c", {"message_id": "SM1"}, {})
+
+    assert (status, msg) == (dynamodb_service.DB_SUCCESS, None)
+    append, release = [c.kwargs for c in mock_client.update_item.call_args_list]
+    assert append['ConditionExpression'] == dynamodb_service.FINAL_UPDATE_REPLY_CONDITION
+    assert append['ExpressionAttributeNames']['#reply_to'] == "last_reply_to"
+    assert unmarshal(append['ExpressionAttributeValues'])[':reply_to'] == "SM1"
+    assert release['UpdateExpression'] == "SET #status = :new_status, #updated = :ts"
+    assert release['ConditionExpression'] == "#status = :lock_status AND #reply_to = :reply_to"
+    assert unmarshal(release['ExpressionAttributeValues'])[':reply_to'] == "SM1"
+
+def test_update_conversation_lock_lost_with_reply_not_stored(mock_dynamodb_resource):
+    mock_client = mock_dynamodb_resource['client']
+    mock_client.update_item.side_effect = [_conditional_check_failed(), _conditional_check_failed()]
+
+    status, _ = dynamodb_service.update_conversation_after_reply("u", "c", {"message_id": "SM1"}, {})
+
+    assert status == dynamodb_service.DB_LOCK_LOST
+    assert mock_client.update_item.call_count == 2
+
 def test_update_conversation_db_error(mock_dynamodb_resource):
     """Test other ClientError during final update."""
-    mock_conv_table = mock_dynamodb_resource['conversations']
-    mock_conv_table.update_item.side_effect = ClientError(
+    mock_client = mock_dynamodb_resource['client']
+    mock_client.update_item.side_effect = ClientError(
         error_response={'Error': {'Code': 'ValidationException'}},
         operation_name='UpdateItem'
     )
@@ -268,6 +312,41 @@ def test_update_conversation_db_error(mock_dynamodb_resource):
     assert status == dynamodb_service.DB_ERROR
     assert "ValidationException" in msg
 
+def test_update_conversation_records_token_usage_and_context_window(mock_dynamodb_resource):
+    """Assistant token counts set context_tokens and add to total_tokens_used; a context window is stored as given."""
+    mock_client = mock_dynamodb_resource['client']
+    assist_msg = {"role": "assistant", "content": "a", "prompt_tokens": 1200, "completion_tokens": 30, "total_tokens": 1230}
+
+    status, _ = dynamodb_service.update_conversation_after_reply(
+        "u", "c", {"role": "user", "content": "u"}, assist_msg,
+        context_window={'strategy': 'truncate', 'covers': 0}
+    )
+
+    assert status == dynamodb_service.DB_SUCCESS
+    call_args = mock_client.update_item.call_args[1]
+    values = unmarshal(call_args['ExpressionAttributeValues'])
+    assert "#ctx_tokens = :ctx_tokens" in call_args['UpdateExpression']
+    assert "#tokens_used = if_not_exists(#tokens_used, :zero) + :tokens_used" in call_args['UpdateExpression']
+    assert values[':ctx_tokens'] == 1200 and values[':tokens_used'] == 1230 and values[':zero'] == 0
+    assert values[':ctx_window'] == {'strategy': 'truncate', 'covers': 0}
+    assert call_args['ExpressionAttributeNames']['#tokens_used'] == 'total_tokens_used'
+
+# --- update_context_window Tests ---
+
+def test_update_context_window_is_conditional_on_covers(mock_dynamodb_resource):
+    mock_client = mock_dynamodb_resource['client']
+    state = {'strategy': 'summarize', 'covers': 12, 'summary': 's'}
+    assert dynamodb_service.update_context_window("u", "c", state, expected_covers=2) is True
+    call_args = mock_client.update_item.call_args[1]
+    values = unmarshal(call_args['ExpressionAttributeValues'])
+    assert call_args['ConditionExpression'] == "#ctx_window.#covers = :expected_covers"
+    assert values == {':ctx_window': state, ':expected_covers': 2}
+
+def test_update_context_window_condition_failure_returns_false(mock_dynamodb_resource):
+    mock_dynamodb_resource['client'].update_item.side_effect = ClientError(
+        error_response={'Error': {'Code': 'ConditionalCheckFailedException'}}, operation_name='UpdateItem')
+    assert dynamodb_service.update_context_window("u", "c", {'covers': 4}, expected_covers=0) is False
+
 # --- cleanup_staging_table Tests ---
 
 def test_cleanup_staging_table_success(mock_dynamodb_resource):
@@ -319,6 +398,27 @@ def test_cleanup_staging_table_db_error(mock_dynamodb_resource):
     result = dynamodb_service.cleanup_staging_table([{'conversation_id': 'c1', 'message_sid': 's1'}])
     assert result is False
 
+# --- Reply Outbox Tests ---
+
+def test_save_reply_outbox_writes_checkpoint_next_to_fragments(mock_dynamodb_resource):
+    mock_client = mock_dynamodb_resource['client']
+    with patch.object(dynamodb_service.time, 'time', return_value=1700000000):
+        result = dynamodb_service.save_reply_outbox('c1', 'SM1', {'stage': dynamodb_service.OUTBOX_SENT, 'sent': []})
+
+    assert result is True
+    request = mock_client.put_item.call_args.kwargs
+    assert request['TableName'] == STAGE_TABLE_NAME
+    item = request['Item']
+    assert item['conversation_id'] == {'S': 'c1'} and item['message_sid'] == {'S': 'outbox#SM1'}
+    assert item['stage'] == {'S': 'sent'}
+    assert item['expires_at'] == {'N': str(1700000000 + dynamodb_service.REPLY_OUTBOX_TTL_SECONDS)}
+    assert dynamodb_service.is_outbox_item({'message_sid': 'outbox#SM1'})
+    assert not dynamodb_service.is_outbox_item({'message_sid': 'SM1'})
+
+def test_save_reply_outbox_db_error(mock_dynamodb_resource):
+    mock_dynamodb_resource['client'].put_item.side_effect = ClientError({'Error': {'Code': 'ValidationException'}}, 'PutItem')
+    assert dynamodb_service.save_reply_outbox('c1', 'SM1', {'stage': dynamodb_service.OUTBOX_AI_COMPLETE}) is False
+
 # --- cleanup_trigger_lock Tests ---
 
 def test_cleanup_trigger_lock_success(mock_dynamodb_resource):
@@ -335,6 +435,20 @@ def test_cleanup_trigger_lock_db_error(mock_dynamodb_resource):
     result = dynamodb_service.cleanup_trigger_lock("conv_del_err")
     assert result is False
 
+def test_cleanup_trigger_lock_with_batch_stats(mock_dynamodb_resource):
+    """Test that batch stats release the trigger and fold counters into the lock item."""
+    mock_lock_table = mock_dynamodb_resource['lock']
+    stats = {'fragment_count': 3, 'gap_sum_ms': 4000, 'gap_count': 2, 'last_fragment_at_ms': 1700000000000}
+    result = dynamodb_service.cleanup_trigger_lock("conv_stats", batch_stats=stats)
+    assert result is True
+    mock_lock_table.delete_item.assert_not_called()
+    kwargs = mock_lock_table.update_item.call_args.kwargs
+    assert kwargs['Key'] == {'conversation_id': "conv_stats"}
+    assert kwargs['UpdateExpression'].startswith("REMOVE trigger_expires_at")
+    assert kwargs['ExpressionAttributeValues'][':frags'] == 3
+    assert kwargs['ExpressionAttributeValues'][':gap_sum'] == 4000
+    assert kwargs['ExpressionAttributeValues'][':gap_count'] == 2
+
 # --- release_lock_for_retry Tests ---
 
 @patch('src.messaging_lambda.whatsapp.lambda_pkg.services.dynamodb_service.datetime')
@@ -362,4 +476,153 @@ def test_release_lock_for_retry_db_error(mock_dynamodb_resource):
     mock_conv_table = mock_dynamodb_resource['conversations']
     mock_conv_table.update_item.side_effect = ClientError({'Error': {'Code': 'ValidationException'}}, 'UpdateItem')
     result = dynamodb_service.release_lock_for_retry("u_retry_err", "c_retry_err")
-    assert result is False 
\ No newline at end of file
+    assert result is False 
+# --- Concurrency Semaphore Tests ---
+
+def _conditional_check_failed():
+    return ClientError({'Error': {'Code': 'ConditionalCheckFailedException', 'Message': 'Test'}}, 'UpdateItem')
+
+@patch('src.messaging_lambda.whatsapp.lambda_pkg.services.dynamodb_service.time.time', return_value=1000.0)
+def test_acquire_concurrency_slot_success_prunes_expired(mock_time, mock_dynamodb_resource):
+    """Expired leases are dropped and the new holder written with an optimistic version check."""
+    mock_lock_table = mock_dynamodb_resource['lock']
+    mock_lock_table.get_item.return_value = {'Item': {'holders': {'conv_a': 999, 'conv_b': 2000}, 'version': 4}}
+
+    status = dynamodb_service.acquire_concurrency_slot('ci-1', 'pi-1', 'conv_c', 2)
+
+    assert status == dynamodb_service.SEMAPHORE_ACQUIRED
+    mock_lock_table.get_item.assert_called_once_with(Key={'conversation_id': 'concurrency#ci-1#pi-1'}, ConsistentRead=True)
+    kwargs = mock_lock_table.update_item.call_args.kwargs
+    assert kwargs['ConditionExpression'] == "attribute_not_exists(version) OR version = :version"
+    lease_end = 1000 + dynamodb_service.CONCURRENCY_LEASE_SECONDS
+    assert kwargs['ExpressionAttributeValues'] == {
+        ':holders': {'conv_b': 2000, 'conv_c': lease_end}, ':new_version': 5, ':version': 4, ':exp': lease_end
+    }
+
+@patch('src.messaging_lambda.whatsapp.lambda_pkg.services.dynamodb_service.time.time', return_value=1000.0)
+def test_acquire_concurrency_slot_full(mock_time, mock_dynamodb_resource):
+    mock_lock_table = mock_dynamodb_resource['lock']
+    mock_lock_table.get_item.return_value = {'Item': {'holders': {'conv_a': 2000, 'conv_b': 2000}, 'version': 1}}
+    assert dynamodb_service.acquire_concurrency_slot('ci-1', 'pi-1', 'conv_c', 2) == dynamodb_service.SEMAPHORE_FULL
+    mock_lock_table.update_item.assert_not_called()
+
+@patch('src.messaging_lambda.whatsapp.lambda_pkg.services.dynamodb_service.time.time', return_value=1000.0)
+def test_acquire_concurrency_slot_existing_holder_renews(mock_time, mock_dynamodb_resource):
+    """A redelivered trigger for a conversation that already holds a slot is not blocked by the cap."""
+    mock_lock_table = mock_dynamodb_resource['lock']
+    mock_lock_table.get_item.return_value = {'Item': {'holders': {'conv_a': 2000}, 'version': 1}}
+    assert dynamodb_service.acquire_concurrency_slot('ci-1', 'pi-1', 'conv_a', 1) == dynamodb_service.SEMAPHORE_ACQUIRED
+
+def test_acquire_concurrency_slot_retries_on_contention(mock_dynamodb_resource):
+    mock_lock_table = mock_dynamodb_resource['lock']
+    mock_lock_table.get_item.return_value = {}
+    mock_lock_table.update_item.side_effect = [_conditional_check_failed(), {}]
+    assert dynamodb_service.acquire_concurrency_slot('ci-1', 'pi-1', 'conv_a', 3) == dynamodb_service.SEMAPHORE_ACQUIRED
+    assert mock_lock_table.get_item.call_count == 2
+
+def test_acquire_concurrency_slot_gives_up_as_full(mock_dynamodb_resource):
+    mock_lock_table = mock_dynamodb_resource['lock']
+    mock_lock_table.get_item.return_value = {}
+    mock_lock_table.update_item.side_effect = _conditional_check_failed()
+    assert dynamodb_service.acquire_concurrency_slot('ci-1', 'pi-1', 'conv_a', 3) == dynamodb_service.SEMAPHORE_FULL
+    assert mock_lock_table.update_item.call_count == dynamodb_service.SEMAPHORE_MAX_ATTEMPTS
+
+def test_acquire_concurrency_slot_db_error(mock_dynamodb_resource):
+    mock_lock_table = mock_dynamodb_resource['lock']
+    mock_lock_table.get_item.side_effect = ClientError({'Error': {'Code': 'InternalServerError', 'Message': 'Test'}}, 'GetItem')
+    assert dynamodb_service.acquire_concurrency_slot('ci-1', 'pi-1', 'conv_a', 3) == dynamodb_service.DB_ERROR
+
+def test_release_concurrency_slot(mock_dynamodb_resource):
+    mock_lock_table = mock_dynamodb_resource['lock']
+    assert dynamodb_service.release_concurrency_slot('ci-1', 'pi-1', 'conv_a') is True
+    kwargs = mock_lock_table.update_item.call_args.kwargs
+    assert kwargs['Key'] == {'conversation_id': 'concurrency#ci-1#pi-1'}
+    assert kwargs['UpdateExpression'] == "REMOVE holders.#holder SET version = version + :one"
+    assert kwargs['ExpressionAttributeNames'] == {'#holder': 'conv_a'}
+
+def test_release_concurrency_slot_missing_item_is_ok(mock_dynamodb_resource):
+    mock_dynamodb_resource['lock'].update_item.side_effect = _conditional_check_failed()
+    assert dynamodb_service.release_concurrency_slot('ci-1', 'pi-1', 'conv_a') is True
+
+# --- Batch Reply Tests ---
+
+def test_reserve_send_tokens(mock_dynamodb_resource):
+    """The per-sender counter only takes a reservation that keeps it within the limit."""
+    mock_lock_table = mock_dynamodb_resource['lock']
+    mock_lock_table.update_item.return_value = {'Attributes': {'send_count': 5}}
+
+    assert dynamodb_service.reserve_send_tokens('sendrate#+46#1000', 5, 80, 1301) == {'status': 'RESERVED', 'count': 5}
+    kwargs = mock_lock_table.update_item.call_args.kwargs
+    assert kwargs['Key'] == {'conversation_id': 'sendrate#+46#1000'}
+    assert kwargs['ExpressionAttributeValues'] == {':n': 5, ':max_before': 75, ':exp': 1301}
+
+    mock_lock_table.update_item.side_effect = _conditional_check_failed()
+    assert dynamodb_service.reserve_send_tokens('sendrate#+46#1000', 5, 80, 1301) == {'status': 'LIMIT_EXCEEDED'}
+    mock_lock_table.update_item.side_effect = ClientError({'Error': {'Code': 'ValidationException'}}, 'UpdateItem')
+    assert dynamodb_service.reserve_send_tokens('sendrate#+46#1000', 5, 80, 1301) == {'status': dynamodb_service.DB_ERROR}
+
+def test_park_for_batch_stores_request_while_locked(mock_dynamodb_resource):
+    mock_client = mock_dynamodb_resource['client']
+    request = {'custom_id': 'c1:abc', 'combined_body': 'hi', 'first_message_sid': 'SM1', 'message_sids': ['SM1']}
+
+    assert dynamodb_service.park_for_batch("u", "c1", request) == (dynamodb_service.DB_SUCCESS, None)
+
+    call_args = mock_client.update_item.call_args[1]
+    values = unmarshal(call_args['ExpressionAttributeValues'])
+    assert call_args['ConditionExpression'] == "#status = :lock_status"
+    assert values[':batch_status'] == dynamodb_service.BATCH_PENDING_STATUS and values[':batch_req'] == request
+    assert '#custom_id' not in call_args['ExpressionAttributeNames']
+
+def test_park_for_batch_lock_lost(mock_dynamodb_resource):
+    mock_dynamodb_resource['client'].update_item.side_effect = _conditional_check_failed()
+    assert dynamodb_service.park_for_batch("u", "c1", {'custom_id': 'c1:abc'})[0] == dynamodb_service.DB_LOCK_LOST
+
+def test_claim_batch_reply_returns_pending_request(mock_dynamodb_resource):
+    mock_client = mock_dynamodb_resource['client']
+    mock_client.update_item.return_value = {'Attributes': {'batch_request': {'M': {'custom_id': {'S': 'c1:abc'}}},
+                                                           'conversation_status': {'S': 'batch_pending'}}}
+
+    status, request = dynamodb_service.claim_batch_reply("u", "c1", "c1:abc")
+
+    assert (status, request) == (dynamodb_service.LOCK_ACQUIRED, {'custom_id': 'c1:abc'})
+    call_args = mock_client.update_item.call_args[1]
+    assert call_args['ConditionExpression'] == dynamodb_service.BATCH_REQUEST_CONDITION
+    assert call_args['ReturnValues'] == 'UPDATED_OLD'
+    assert unmarshal(call_args['ExpressionAttributeValues'])[':proc_status'] == dynamodb_service.PROCESSING_STATUS
+
+def test_claim_and_release_of_superseded_request(mock_dynamodb_resource):
+    mock_dynamodb_resource['client'].update_item.side_effect = _conditional_check_failed()
+    assert dynamodb_service.claim_batch_reply("u", "c1", "c1:old") == (dynamodb_service.BATCH_SUPERSEDED, None)
+    assert dynamodb_service.release_batch_request("u", "c1", "c1:old") == dynamodb_service.BATCH_SUPERSEDED
+
+@patch('src.messaging_lambda.whatsapp.lambda_pkg.services.dynamodb_service.time.time', return_value=1000.0)
+def test_record_and_close_batch(mock_time, mock_dynamodb_resource):
+    mock_lock_table = mock_dynamodb_resource['lock']
+    requests = {'c1:abc': {'primary_channel': 'u', 'conversation_id': 'c1'}}
+
+    assert dynamodb_service.record_batch('batch_1', 'openai-secret', requests) is True
+    item = mock_lock_table.put_item.call_args.kwargs['Item']
+    assert item['conversation_id'] == 'batch#batch_1' and item['requests'] == requests
+    assert item['expires_at'] == 1000 + dynamodb_service.BATCH_RECORD_TTL_SECONDS
+    assert mock_lock_table.update_item.call_args.kwargs['ExpressionAttributeValues'] == {':batch_id': {'batch_1'}}
+
+    mock_lock_table.get_item.return_value = {'Item': {'batch_ids': {'batch_2', 'batch_1'}}}
+    assert dynamodb_service.list_open_batches() == ['batch_1', 'batch_2']
+    assert dynamodb_service.close_batch('batch_1') is True
+    assert mock_lock_table.update_item.call_args.kwargs['UpdateExpression'] == "DELETE batch_ids :batch_id"
+    mock_lock_table.delete_item.assert_called_once_with(Key={'conversation_id': 'batch#batch_1'})
+
+def test_scan_conversations_by_status_pages_and_filters(mock_dynamodb_resource):
+    mock_conv_table = mock_dynamodb_resource['conversations']
+    mock_conv_table.scan.side_effect = [
+        {'Items': [{'primary_channel': 'u1', 'conversation_id': 'c1'}], 'LastEvaluatedKey': {'k': 1}},
+        {'Items': [{'primary_channel': 'u2', 'conversation_id': 'c2'}]},
+    ]
+
+    keys = dynamodb_service.scan_conversations_by_status(('retry',), project_id='pi-1')
+
+    assert [key['conversation_id'] for key in keys] == ['c1', 'c2']
+    first, second = mock_conv_table.scan.call_args_list
+    assert first.kwargs['FilterExpression'] == "#status IN (:s0) AND #project_id = :project_id"
+    assert first.kwargs['ExpressionAttributeValues'] == {':s0': 'retry', ':project_id': 'pi-1'}
+    assert second.kwargs['ExclusiveStartKey'] == {'k': 1}
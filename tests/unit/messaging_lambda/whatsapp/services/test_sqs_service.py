@@ -0,0 +1,78 @@
+import pytest
+from unittest.mock import patch, MagicMock
+from botocore.exceptions import ClientError
+
+# Use the correct absolute import path based on project structure
+from src.messaging_lambda.whatsapp.lambda_pkg.services import sqs_service
+
+# --- Fixtures ---
+
+@pytest.fixture
+def mock_sqs_client():
+    """Replaces the module-level SQS client."""
+    mock_client = MagicMock()
+    with patch('src.messaging_lambda.whatsapp.lambda_pkg.services.sqs_service.sqs', mock_client):
+        yield mock_client
+
+# --- Test Cases ---
+
+def test_defer_message_extends_visibility(mock_sqs_client):
+    status = sqs_service.defer_message('queue-url', 'handle-1', '{"conversation_id": "c1"}', 1, 25)
+    assert status == sqs_service.SQS_DEFERRED
+    mock_sqs_client.change_message_visibility.assert_called_once_with(
+        QueueUrl='queue-url', ReceiptHandle='handle-1', VisibilityTimeout=25
+    )
+    mock_sqs_client.send_message.assert_not_called()
+
+def test_defer_message_requeues_after_repeated_receives(mock_sqs_client):
+    """Repeated deferrals must not walk the message into the DLQ via maxReceiveCount."""
+    body = '{"conversation_id": "c1"}'
+    status = sqs_service.defer_message('queue-url', 'handle-1', body, sqs_service.DEFER_REQUEUE_RECEIVE_COUNT, 25)
+    assert status == sqs_service.SQS_REQUEUED
+    mock_sqs_client.send_message.assert_called_once_with(QueueUrl='queue-url', MessageBody=body, DelaySeconds=25)
+    mock_sqs_client.change_message_visibility.assert_not_called()
+
+def test_defer_message_on_fifo_queue_always_extends_visibility(mock_sqs_client):
+    """FIFO queues reject a per-message DelaySeconds, so there is no delayed re-send."""
+    status = sqs_service.defer_message('queue-url.fifo', 'handle-1', 'body', sqs_service.DEFER_REQUEUE_RECEIVE_COUNT + 1, 25)
+    assert status == sqs_service.SQS_DEFERRED
+    mock_sqs_client.send_message.assert_not_called()
+    mock_sqs_client.change_message_visibility.assert_called_once_with(
+        QueueUrl='queue-url.fifo', ReceiptHandle='handle-1', VisibilityTimeout=25
+    )
+
+def test_defer_message_clamps_delay(mock_sqs_client):
+    sqs_service.defer_message('queue-url', 'handle-1', 'body', 5, 5000)
+    assert mock_sqs_client.send_message.call_args.kwargs['DelaySeconds'] == sqs_service.SQS_MAX_DELAY_SECONDS
+
+def test_defer_message_client_error(mock_sqs_client):
+    mock_sqs_client.change_message_visibility.side_effect = ClientError(
+        {'Error': {'Code': 'ReceiptHandleIsInvalid', 'Message': 'Test'}}, 'ChangeMessageVisibility'
+    )
+    assert sqs_service.defer_message('queue-url', 'handle-1', 'body', 1, 25) == sqs_service.SQS_ERROR
+
+def test_send_message_adds_fifo_group_and_deduplication(mock_sqs_client):
+    assert sqs_service.send_message('queue-url.fifo', {'a': 1}, group_id='c' * 200, deduplication_id='d1') == sqs_service.SQS_SENT
+    kwargs = mock_sqs_client.send_message.call_args.kwargs
+    assert kwargs['MessageBody'] == '{"a": 1}' and kwargs['MessageDeduplicationId'] == 'd1'
+    assert len(kwargs['MessageGroupId']) == 64
+
+def test_send_message_rejects_oversized_body(mock_sqs_client):
+    assert sqs_service.send_message('queue-url', {'a': 'x' * sqs_service.SQS_MAX_MESSAGE_BYTES}) == sqs_service.SQS_ERROR
+    mock_sqs_client.send_message.assert_not_called()
+
+def test_receive_messages_until_queue_is_empty(mock_sqs_client):
+    mock_sqs_client.receive_message.side_effect = [
+        {'Messages': [{'ReceiptHandle': f'h{n}', 'Body': '{"n": %d}' % n} for n in range(10)]},
+        {'Messages': [{'ReceiptHandle': 'h10', 'Body': 'not json', 'MessageId': 'm10'}]},
+        {},
+    ]
+    messages = sqs_service.receive_messages('queue-url', 25, visibility_timeout=300)
+    assert [handle for handle, _ in messages] == [f'h{n}' for n in range(10)]
+    assert mock_sqs_client.receive_message.call_args_list[1].kwargs['MaxNumberOfMessages'] == 10
+    assert mock_sqs_client.receive_message.call_args.kwargs['VisibilityTimeout'] == 300
+
+def test_delete_messages_in_chunks_of_ten(mock_sqs_client):
+    mock_sqs_client.delete_message_batch.return_value = {'Failed': []}
+    assert sqs_service.delete_messages('queue-url', [f'h{n}' for n in range(12)]) is True
+    assert [len(c.kwargs['Entries']) for c in mock_sqs_client.delete_message_batch.call_args_list] == [10, 2]
@@ -68,7 +68,7 @@ def test_send_whatsapp_reply_missing_args():
 @pytest.mark.parametrize("status_code, error_code, expected_status", [
     (400, 21211, twilio_service.TWILIO_NON_TRANSIENT_ERROR), # Invalid 'To' number
     (403, 20003, twilio_service.TWILIO_NON_TRANSIENT_ERROR), # Auth error
-    (429, 20429, twilio_service.TWILIO_NON_TRANSIENT_ERROR), # Rate limit (treat non-transient here as per code)
+    (429, 20429, twilio_service.TWILIO_TRANSIENT_ERROR),     # Rate limit (sender throughput) - retried later
     (500, 20500, twilio_service.TWILIO_TRANSIENT_ERROR),     # Internal Twilio error
     (503, 20503, twilio_service.TWILIO_TRANSIENT_ERROR),     # Service unavailable
     (300, 99999, twilio_service.TWILIO_NON_TRANSIENT_ERROR) # Unexpected status
@@ -92,4 +92,71 @@ def test_send_whatsapp_reply_unexpected_exception(mock_twilio_client, valid_cred
 
     assert status == twilio_service.TWILIO_TRANSIENT_ERROR # Assumes transient
     assert "Unexpected error sending message via Twilio" in result['error_message']
-    assert str(test_exception) in result['error_message'] 
\ No newline at end of file
+    assert str(test_exception) in result['error_message'] 
+def test_send_whatsapp_parts_sends_in_order_on_one_client(valid_creds):
+    """Parts go out one after another through a single client; every SID is returned."""
+    client = MagicMock()
+    client.messages.create.side_effect = [MagicMock(sid=f"SM{n}", status='queued', body=f"part {n}") for n in (1, 2)]
+    with patch('src.messaging_lambda.whatsapp.lambda_pkg.services.twilio_service.Client', return_value=client) as constructor:
+        status, result = twilio_service.send_whatsapp_parts(valid_creds, "+1", "+2", ["part 1", "part 2"])
+
+    assert status == twilio_service.TWILIO_SUCCESS
+    assert result == {'message_sid': 'SM1', 'body': 'part 1\n\npart 2', 'message_sids': ['SM1', 'SM2']}
+    constructor.assert_called_once()
+    assert [c.kwargs['body'] for c in client.messages.create.call_args_list] == ["part 1", "part 2"]
+
+def test_send_whatsapp_parts_stops_at_first_failure(valid_creds):
+    """A failed part stops the send; the payload lists the parts already delivered."""
+    client = MagicMock()
+    client.messages.create.side_effect = [
+        MagicMock(sid="SM1", status='queued', body="part 1"),
+        TwilioRestException(status=503, uri="/Messages", msg="Unavailable", code=20503),
+    ]
+    with patch('src.messaging_lambda.whatsapp.lambda_pkg.services.twilio_service.Client', return_value=client):
+        status, result = twilio_service.send_whatsapp_parts(valid_creds, "+1", "+2", ["part 1", "part 2", "part 3"])
+
+    assert status == twilio_service.TWILIO_TRANSIENT_ERROR
+    assert result['sent'] == [{'message_sid': 'SM1', 'body': 'part 1'}]
+    assert client.messages.create.call_count == 2
+
+def test_send_whatsapp_parts_missing_args(valid_creds):
+    status, result = twilio_service.send_whatsapp_parts(valid_creds, "+1", "+2", [])
+    assert status == twilio_service.TWILIO_INVALID_INPUT
+
+def test_clients_share_one_pooled_http_client(mock_twilio_client, valid_creds):
+    """Every send reuses the container's pooled HTTP session."""
+    with patch.object(twilio_service, '_http_client', None), \
+         patch('src.messaging_lambda.whatsapp.lambda_pkg.services.twilio_service.Client') as constructor:
+        twilio_service.send_whatsapp_reply(valid_creds, "+1", "+2", "one")
+        twilio_service.send_whatsapp_reply(valid_creds, "+1", "+2", "two")
+        http_clients = {c.kwargs['http_client'] for c in constructor.call_args_list}
+
+    assert len(http_clients) == 1
+    assert http_clients.pop().session is not None
+
+def test_paced_send_retries_after_rate_limit(mock_twilio_client, valid_creds):
+    """With a pacer, a 429 backs the sender off and the message is sent again."""
+    rate_limited = TwilioRestException(status=429, uri="/Messages", msg="Too Many Requests", code=20429)
+    mock_twilio_client.messages.create.side_effect = [rate_limited, mock_twilio_client.messages.create.return_value]
+    pace = MagicMock(return_value=True)
+
+    status, result = twilio_service.send_whatsapp_reply(valid_creds, "+1", "+2", "body", pace=pace)
+
+    assert status == twilio_service.TWILIO_SUCCESS
+    assert [c.kwargs for c in pace.call_args_list] == [{'throttled': False}, {'throttled': True}]
+
+def test_paced_send_without_a_slot_is_transient(mock_twilio_client, valid_creds):
+    """No free send slot within the wait budget means a retry later, not a send."""
+    status, result = twilio_service.send_whatsapp_reply(valid_creds, "+1", "+2", "body", pace=MagicMock(return_value=False))
+
+    assert status == twilio_service.TWILIO_TRANSIENT_ERROR
+    assert result['rate_limited'] is True
+    mock_twilio_client.messages.create.assert_not_called()
+
+def test_unpaced_rate_limit_is_not_retried(mock_twilio_client, valid_creds):
+    mock_twilio_client.messages.create.side_effect = TwilioRestException(status=429, uri="/Messages", msg="Too Many Requests", code=20429)
+
+    status, result = twilio_service.send_whatsapp_reply(valid_creds, "+1", "+2", "body")
+
+    assert (status, result['rate_limited']) == (twilio_service.TWILIO_TRANSIENT_ERROR, True)
+    assert mock_twilio_client.messages.create.call_count == 1
@@ -0,0 +1,73 @@
+import pytest
+from unittest.mock import patch, MagicMock
+
+from src.messaging_lambda.whatsapp.lambda_pkg import batch_runner
+from src.messaging_lambda.whatsapp.lambda_pkg.core.openai_service import (
+    AI_SUCCESS, AI_TRANSIENT_ERROR, AI_NON_TRANSIENT_ERROR
+)
+
+BATCH_QUEUE_URL = 'https://sqs.eu-north-1.amazonaws.com/123/batch-queue'
+WHATSAPP_QUEUE_URL = 'https://sqs.eu-north-1.amazonaws.com/123/whatsapp-queue'
+
+# --- Helpers & Fixtures ---
+
+def queued(custom_id, model='gpt-4o', secret='openai-secret'):
+    return (f"handle-{custom_id}", {'custom_id': custom_id, 'primary_channel': 'u', 'conversation_id': custom_id.split(':')[0],
+                                    'api_key_reference': secret, 'body': {'model': model, 'messages': []}})
+
+@pytest.fixture
+def services():
+    with patch.object(batch_runner, 'BATCH_QUEUE_URL', BATCH_QUEUE_URL), \
+         patch.object(batch_runner, 'WHATSAPP_QUEUE_URL', WHATSAPP_QUEUE_URL), \
+         patch.object(batch_runner, 'sqs_service') as sqs, \
+         patch.object(batch_runner, 'dynamodb_service') as db, \
+         patch.object(batch_runner, 'batch_service') as batches, \
+         patch.object(batch_runner, '_api_key', return_value='sk-a'):
+        db.DB_SUCCESS, db.DB_ERROR, db.BATCH_SUPERSEDED = 'SUCCESS', 'DB_ERROR', 'SUPERSEDED'
+        sqs.SQS_SENT = 'SENT'
+        sqs.send_message.return_value = 'SENT'
+        yield MagicMock(sqs=sqs, db=db, batches=batches)
+
+# --- Test Cases ---
+
+def test_submit_pending_makes_one_batch_per_model_and_deletes_recorded_requests(services):
+    services.sqs.receive_messages.return_value = [queued('c1:a'), queued('c2:b', model='gpt-4o-mini'), queued('c3:c'), queued('c1:a')]
+    services.batches.submit.side_effect = [(AI_SUCCESS, {'batch_id': 'batch_1'}), (AI_SUCCESS, {'batch_id': 'batch_2'})]
+    services.db.record_batch.side_effect = [True, False]
+
+    assert batch_runner.submit_pending() == 2
+
+    first_requests = services.batches.submit.call_args_list[0].args[1]
+    assert [request['custom_id'] for request in first_requests] == ['c1:a', 'c3:c']
+    services.sqs.delete_messages.assert_called_once_with(BATCH_QUEUE_URL, ['handle-c1:a', 'handle-c3:c', 'handle-c1:a'])
+
+def test_transient_failure_releases_conversation_and_sends_reprocess_trigger(services):
+    services.db.release_batch_request.return_value = 'SUCCESS'
+    outcome = batch_runner.deliver_reply('u', 'c1', 'c1:a', AI_TRANSIENT_ERROR, {'error_message': 'expired'})
+    assert outcome == batch_runner.RETRY
+    body = services.sqs.send_message.call_args.args[1]
+    assert body == {'conversation_id': 'c1', 'primary_channel': 'u', 'reprocess': True}
+    assert services.sqs.send_message.call_args.kwargs['group_id'] == 'c1'
+
+def test_non_transient_failure_leaves_conversation_in_retry(services):
+    services.db.release_batch_request.return_value = 'SUCCESS'
+    assert batch_runner.deliver_reply('u', 'c1', 'c1:a', AI_NON_TRANSIENT_ERROR, {}) == batch_runner.FAILED
+    services.sqs.send_message.assert_not_called()
+
+def test_collect_results_keeps_batch_open_after_db_error(services):
+    services.db.list_open_batches.return_value = ['batch_1']
+    services.db.get_batch_record.return_value = {'api_key_reference': 's', 'requests': {
+        'c1:a': {'primary_channel': 'u', 'conversation_id': 'c1'}}}
+    services.batches.BATCH_ENDED = 'ENDED'
+    services.batches.poll.return_value = (AI_SUCCESS, {'state': 'ENDED', 'status': 'completed', 'results': {}})
+    services.batches.missing_result.return_value = (AI_TRANSIENT_ERROR, {})
+    services.db.release_batch_request.return_value = 'DB_ERROR'
+
+    assert batch_runner.collect_results() == {batch_runner.DB_ERROR: 1}
+    services.db.close_batch.assert_not_called()
+
+def test_reprocess_action_sends_a_trigger_per_conversation(services):
+    services.db.scan_conversations_by_status.return_value = [
+        {'primary_channel': 'u1', 'conversation_id': 'c1'}, {'primary_channel': 'u2', 'conversation_id': 'c2'}]
+    assert batch_runner.handler({'action': 'reprocess', 'company_id': 'ci-1'}, None) == {'reprocess_triggers': 2}
+    services.db.scan_conversations_by_status.assert_called_once_with(('retry',), 'ci-1', None, None)
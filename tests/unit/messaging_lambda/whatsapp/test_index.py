@@ -8,6 +8,7 @@ from src.messaging_lambda.whatsapp.lambda_pkg import index
 from src.messaging_lambda.whatsapp.lambda_pkg.services import dynamodb_service
 from src.messaging_lambda.whatsapp.lambda_pkg.services import secrets_manager_service
 from src.messaging_lambda.whatsapp.lambda_pkg.services import twilio_service
+from src.messaging_lambda.whatsapp.lambda_pkg.utils import metrics
 
 # --- Fixtures ---
 
@@ -88,6 +89,11 @@ def mock_dependencies(monkeypatch):
             mock_ddb.cleanup_staging_table.return_value = True
             mock_ddb.cleanup_trigger_lock.return_value = True
             mock_ddb.release_lock_for_retry.return_value = True
+            mock_ddb.OUTBOX_AI_COMPLETE = dynamodb_service.OUTBOX_AI_COMPLETE
+            mock_ddb.OUTBOX_SENT = dynamodb_service.OUTBOX_SENT
+            mock_ddb.is_outbox_item.side_effect = dynamodb_service.is_outbox_item
+            mock_ddb.outbox_key.side_effect = dynamodb_service.outbox_key
+            mock_ddb.save_reply_outbox.return_value = True
             # --- End mock_ddb config ---
 
             # --- Configure mock_sm --- #
@@ -181,13 +187,79 @@ def test_handler_success_single_message(mock_sqs_event, mock_lambda_context, moc
     )
     mock_dependencies['ddb'].cleanup_staging_table.assert_called_once_with([
         {'conversation_id': 'conv_test_123', 'message_sid': 'SM1'},
-        {'conversation_id': 'conv_test_123', 'message_sid': 'SM2'}
+        {'conversation_id': 'conv_test_123', 'message_sid': 'SM2'},
+        {'conversation_id': 'conv_test_123', 'message_sid': 'outbox#SM1'}
     ])
-    mock_dependencies['ddb'].cleanup_trigger_lock.assert_called_once_with('conv_test_123')
+    mock_dependencies['ddb'].cleanup_trigger_lock.assert_called_once_with('conv_test_123', batch_stats=ANY)
     mock_dependencies['heartbeat_instance'].stop.assert_called_once()
     mock_dependencies['heartbeat_instance'].check_for_errors.assert_called_once()
     mock_dependencies['ddb'].release_lock_for_retry.assert_not_called()
 
+def test_hydration_overlays_cached_company_config(mock_sqs_event, mock_lambda_context, mock_dependencies):
+    """With a company-data table, hydration projects per-conversation fields and overlays the company config."""
+    item = mock_dependencies['ddb'].get_conversation_item.return_value
+    item.update({'company_id': 'ci-1', 'project_id': 'pi-1', 'channel_method': 'whatsapp'})
+    del item['ai_config']
+    record = {'ai_config': {'openai_config': {'whatsapp': {'api_key_reference': 'openai_ref', 'assistant_id_replies': 'asst_new'}}}}
+    with patch('src.messaging_lambda.whatsapp.lambda_pkg.index.company_config_service.is_enabled', return_value=True), \
+         patch('src.messaging_lambda.whatsapp.lambda_pkg.index.company_config_service.get_company_config',
+               return_value=('FOUND', record)) as mock_config:
+        index.handler(mock_sqs_event, mock_lambda_context)
+
+    mock_config.assert_called_once_with('ci-1', 'pi-1')
+    mock_dependencies['ddb'].get_conversation_item.assert_called_once_with(
+        'user_num_123', 'conv_test_123', attributes=mock_dependencies['ddb'].CONVERSATION_FIELDS
+    )
+    assert mock_dependencies['openai'].process_reply_with_ai.call_args.kwargs['assistant_id'] == 'asst_new'
+
+def test_context_budget_limits_run_and_activates_window(mock_sqs_event, mock_lambda_context, mock_dependencies):
+    """A reply whose prompt reaches the budget stores a context window; an active window truncates the run."""
+    item = mock_dependencies['ddb'].get_conversation_item.return_value
+    item['ai_config']['context_window'] = {'max_prompt_tokens': 10, 'strategy': 'truncate', 'keep_last_messages': 4}
+
+    index.handler(mock_sqs_event, mock_lambda_context)
+    assert mock_dependencies['openai'].process_reply_with_ai.call_args.kwargs['run_options'] == {}
+    assert mock_dependencies['ddb'].update_conversation_after_reply.call_args.kwargs['context_window'] == \
+        {'strategy': 'truncate', 'covers': 0}
+
+    item['context_window'] = {'strategy': 'truncate', 'covers': 0}
+    mock_dependencies['sm'].get_secret.side_effect = [
+        ("SUCCESS", {'ai_api_key': 'sk-123'}),
+        ("SUCCESS", {'twilio_account_sid': 'ACxxx', 'twilio_auth_token': 'token'})
+    ]
+    index.handler(mock_sqs_event, mock_lambda_context)
+    assert mock_dependencies['openai'].process_reply_with_ai.call_args.kwargs['run_options'] == \
+        {'truncation_strategy': {'type': 'last_messages', 'last_messages': 5}}
+    assert 'context_window' not in mock_dependencies['ddb'].update_conversation_after_reply.call_args.kwargs
+
+def test_hydration_falls_back_to_full_item_without_company_config(mock_sqs_event, mock_lambda_context, mock_dependencies):
+    with patch('src.messaging_lambda.whatsapp.lambda_pkg.index.company_config_service.is_enabled', return_value=True), \
+         patch('src.messaging_lambda.whatsapp.lambda_pkg.index.company_config_service.get_company_config',
+               return_value=('NOT_FOUND', None)):
+        index.handler(mock_sqs_event, mock_lambda_context)
+
+    calls = mock_dependencies['ddb'].get_conversation_item.call_args_list
+    assert calls == [call('user_num_123', 'conv_test_123', attributes=ANY), call('user_num_123', 'conv_test_123')]
+    mock_dependencies['twilio'].send_whatsapp_reply.assert_called_once()
+
+def test_handler_emits_stage_metrics(mock_sqs_event, mock_lambda_context, mock_dependencies):
+    """Test stage timings are flushed once per invocation, tagged with channel and company."""
+    mock_dependencies['ddb'].get_conversation_item.return_value['company_id'] = 'ci-aaa-000'
+    sink = metrics.MemorySink()
+    previous = metrics.set_sink(sink)
+    try:
+        index.handler(mock_sqs_event, mock_lambda_context)
+    finally:
+        metrics.set_sink(previous)
+
+    assert len(sink.documents) == 1
+    document = sink.documents[0]
+    assert document['Channel'] == 'whatsapp'
+    assert document['CompanyId'] == 'ci-aaa-000'
+    for stage in ('processing_lock', 'stage_query', 'hydration', 'ai_total', 'twilio_send', 'finalize', 'cleanup', 'record_total'):
+        assert len(sink.values(stage)) == 1, stage
+    assert len(sink.values('secrets')) == 2
+
 def test_handler_lock_exists(mock_sqs_event, mock_lambda_context, mock_dependencies):
     """Test when the processing lock already exists."""
     # Configure the mock to return LOCK_EXISTS
@@ -325,6 +397,38 @@ def test_handler_twilio_permanent_error(mock_sqs_event, mock_lambda_context, moc
     mock_dependencies['ddb'].release_lock_for_retry.assert_called_once_with('user_num_123', 'conv_test_123')
     mock_dependencies['heartbeat_instance'].stop.assert_called_once()
 
+def test_handler_splits_over_length_reply(mock_sqs_event, mock_lambda_context, mock_dependencies):
+    """A reply longer than one message goes out in ordered parts and history keeps every SID."""
+    long_reply = ' '.join(f"Sentence number {n} of a long answer." for n in range(80))
+    mock_dependencies['openai'].process_reply_with_ai.return_value = ("SUCCESS", {
+        'response_content': json.dumps({'content': long_reply}),
+        'prompt_tokens': 10, 'completion_tokens': 5, 'total_tokens': 15
+    })
+    mock_dependencies['twilio'].send_whatsapp_parts.return_value = ("SUCCESS", {
+        'message_sid': 'SM_part_1', 'body': 'joined', 'message_sids': ['SM_part_1', 'SM_part_2']
+    })
+
+    response = index.handler(mock_sqs_event, mock_lambda_context)
+
+    assert response == {"batchItemFailures": []}
+    mock_dependencies['twilio'].send_whatsapp_reply.assert_not_called()
+    parts = mock_dependencies['twilio'].send_whatsapp_parts.call_args.args[3]
+    assert len(parts) == 2 and all(len(part) <= 1600 for part in parts)
+    assistant_map = mock_dependencies['ddb'].update_conversation_after_reply.call_args.kwargs['assistant_message_map']
+    assert assistant_map['message_id'] == 'SM_part_1'
+    assert assistant_map['message_sids'] == ['SM_part_1', 'SM_part_2']
+    assert assistant_map['content'] == long_reply
+
+def test_handler_paces_sends_under_sender_rate_limit(mock_sqs_event, mock_lambda_context, mock_dependencies):
+    """A company sender limit binds the limiter to the company number for the Twilio send."""
+    mock_dependencies['ddb'].get_conversation_item.return_value['rate_limits'] = {'sender_messages_per_second': 20}
+
+    index.handler(mock_sqs_event, mock_lambda_context)
+
+    pace = mock_dependencies['twilio'].send_whatsapp_reply.call_args.kwargs['pace']
+    assert pace.func is index.sender_rate_limiter.acquire
+    assert pace.args == ('+444', 20, mock_dependencies['ddb'].reserve_send_tokens)
+
 def test_handler_final_update_lock_lost(mock_sqs_event, mock_lambda_context, mock_dependencies):
     """Test lock lost error during final DB update - should NOT fail SQS message."""
     mock_dependencies['ddb'].update_conversation_after_reply.return_value = (dynamodb_service.DB_LOCK_LOST, "Lock lost")
@@ -349,11 +453,24 @@ def test_handler_final_update_lock_lost(mock_sqs_event, mock_lambda_context, moc
     mock_dependencies['heartbeat_instance'].stop.assert_called_once()
 
 def test_handler_final_update_db_error(mock_sqs_event, mock_lambda_context, mock_dependencies):
-    """Test DB error during final DB update - should NOT fail SQS message."""
+    """DB error during the final update of a reply checkpointed as sent - fails the record so the retry stores it."""
     mock_dependencies['ddb'].update_conversation_after_reply.return_value = (dynamodb_service.DB_ERROR, "Update failed")
 
     response = index.handler(mock_sqs_event, mock_lambda_context)
 
+    stages = [c.args[2]['stage'] for c in mock_dependencies['ddb'].save_reply_outbox.call_args_list]
+    assert stages == [dynamodb_service.OUTBOX_AI_COMPLETE, dynamodb_service.OUTBOX_SENT]
+    assert response == {"batchItemFailures": [{"itemIdentifier": "msg1"}]}
+    mock_dependencies['ddb'].cleanup_staging_table.assert_not_called()
+    mock_dependencies['ddb'].release_lock_for_retry.assert_called_once_with('user_num_123', 'conv_test_123')
+
+def test_handler_final_update_db_error_without_outbox(mock_sqs_event, mock_lambda_context, mock_dependencies):
+    """Test DB error during final DB update without an outbox - should NOT fail SQS message."""
+    mock_dependencies['ddb'].update_conversation_after_reply.return_value = (dynamodb_service.DB_ERROR, "Update failed")
+
+    with patch.object(index, 'REPLY_OUTBOX_ENABLED', False):
+        response = index.handler(mock_sqs_event, mock_lambda_context)
+
     # Verify calls up to the update attempt
     mock_dependencies['ddb'].acquire_processing_lock.assert_called_once()
     mock_dependencies['heartbeat_instance'].start.assert_called_once()
@@ -371,6 +488,105 @@ def test_handler_final_update_db_error(mock_sqs_event, mock_lambda_context, mock
     mock_dependencies['ddb'].release_lock_for_retry.assert_not_called()
     mock_dependencies['heartbeat_instance'].stop.assert_called_once()
 
+def _outbox(stage='ai_complete', message_sids=('SM1', 'SM2'), content='Mock AI Reply', **fields):
+    return dict({
+        'conversation_id': 'conv_test_123', 'message_sid': 'outbox#SM1', 'first_message_sid': 'SM1',
+        'primary_channel': 'user_num_123', 'combined_body': 'Hello\nThere', 'message_sids': list(message_sids),
+        'stage': stage, 'sent': [], 'created_at': 1700000000,
+        'ai_response': {'response_content': json.dumps({'content': content}),
+                        'prompt_tokens': 10, 'completion_tokens': 5, 'total_tokens': 15}
+    }, **fields)
+
+def test_handler_resumes_sent_outbox_without_ai_or_send(mock_sqs_event, mock_lambda_context, mock_dependencies):
+    """A reply the outbox marks as sent is only stored: no AI run and no second message."""
+    staged = mock_dependencies['ddb'].query_staging_table.return_value
+    staged.append(_outbox('sent', twilio_response={'message_sid': 'SM_earlier', 'body': 'Mock AI Reply'}))
+
+    response = index.handler(mock_sqs_event, mock_lambda_context)
+
+    assert response == {"batchItemFailures": []}
+    mock_dependencies['openai'].process_reply_with_ai.assert_not_called()
+    mock_dependencies['twilio'].send_whatsapp_reply.assert_not_called()
+    mock_dependencies['ddb'].save_reply_outbox.assert_not_called()
+    kwargs = mock_dependencies['ddb'].update_conversation_after_reply.call_args.kwargs
+    assert kwargs['assistant_message_map']['message_id'] == 'SM_earlier'
+    assert kwargs['user_message_map']['content'] == 'Hello\nThere'
+    keys = mock_dependencies['ddb'].cleanup_staging_table.call_args.args[0]
+    assert [key['message_sid'] for key in keys] == ['SM1', 'SM2', 'outbox#SM1']
+
+def test_handler_resumes_outbox_after_fragments_expired(mock_sqs_event, mock_lambda_context, mock_dependencies):
+    """The outbox alone is enough to finish the reply once its fragments' TTL passed."""
+    mock_dependencies['ddb'].query_staging_table.return_value = [_outbox()]
+
+    response = index.handler(mock_sqs_event, mock_lambda_context)
+
+    assert response == {"batchItemFailures": []}
+    mock_dependencies['openai'].process_reply_with_ai.assert_not_called()
+    assert mock_dependencies['twilio'].send_whatsapp_reply.call_args.kwargs['message_body'] == 'Mock AI Reply'
+    assert mock_dependencies['ddb'].save_reply_outbox.call_args.args[2]['stage'] == dynamodb_service.OUTBOX_SENT
+
+def test_handler_sends_only_the_parts_not_yet_sent(mock_sqs_event, mock_lambda_context, mock_dependencies):
+    reply = 'First part of the answer.\n\nSecond part of the answer.'
+    mock_dependencies['ddb'].query_staging_table.return_value.append(
+        _outbox(content=reply, sent=[{'message_sid': 'SM_part_1', 'body': 'First part of the answer.'}]))
+    mock_dependencies['twilio'].send_whatsapp_reply.return_value = ("SUCCESS", {'message_sid': 'SM_part_2', 'body': 'x'})
+
+    response = index.handler(mock_sqs_event, mock_lambda_context)
+
+    assert response == {"batchItemFailures": []}
+    assert mock_dependencies['twilio'].send_whatsapp_reply.call_args.kwargs['message_body'] == 'Second part of the answer.'
+    assistant_map = mock_dependencies['ddb'].update_conversation_after_reply.call_args.kwargs['assistant_message_map']
+    assert assistant_map['message_sids'] == ['SM_part_1', 'SM_part_2']
+    assert assistant_map['content'] == reply
+
+def test_handler_records_parts_sent_before_a_twilio_failure(mock_sqs_event, mock_lambda_context, mock_dependencies):
+    long_reply = ' '.join(f"Sentence number {n} of a long answer." for n in range(80))
+    mock_dependencies['openai'].process_reply_with_ai.return_value = ("SUCCESS", {
+        'response_content': json.dumps({'content': long_reply}),
+        'prompt_tokens': 10, 'completion_tokens': 5, 'total_tokens': 15
+    })
+    mock_dependencies['twilio'].send_whatsapp_parts.return_value = ("TRANSIENT_ERROR", {
+        'error_message': 'Service unavailable', 'sent': [{'message_sid': 'SM_part_1', 'body': 'part one', 'status': 'queued'}]
+    })
+
+    response = index.handler(mock_sqs_event, mock_lambda_context)
+
+    assert response == {"batchItemFailures": [{"itemIdentifier": "msg1"}]}
+    records = [c.args[2] for c in mock_dependencies['ddb'].save_reply_outbox.call_args_list]
+    assert [r['stage'] for r in records] == [dynamodb_service.OUTBOX_AI_COMPLETE] * 2
+    assert records[-1]['sent'] == [{'message_sid': 'SM_part_1', 'body': 'part one'}]
+    assert records[-1]['message_sids'] == ['SM1', 'SM2']
+
+def test_handler_regenerates_unsent_outbox_when_new_fragments_arrived(mock_sqs_event, mock_lambda_context, mock_dependencies):
+    """Nothing was sent yet, so the reply is generated again for all the messages."""
+    mock_dependencies['ddb'].query_staging_table.return_value.append(_outbox(message_sids=('SM1',)))
+
+    response = index.handler(mock_sqs_event, mock_lambda_context)
+
+    assert response == {"batchItemFailures": []}
+    mock_dependencies['openai'].process_reply_with_ai.assert_called_once()
+    assert mock_dependencies['ddb'].save_reply_outbox.call_args_list[0].args[2]['message_sids'] == ['SM1', 'SM2']
+    keys = mock_dependencies['ddb'].cleanup_staging_table.call_args.args[0]
+    assert [key['message_sid'] for key in keys] == ['SM1', 'SM2', 'outbox#SM1']
+
+@patch('src.messaging_lambda.whatsapp.lambda_pkg.index.sqs_service')
+def test_handler_requeues_fragments_after_a_resumed_reply(mock_sqs_service, mock_sqs_event, mock_lambda_context, mock_dependencies):
+    """A sent reply is stored for its own messages; later fragments get a fresh trigger."""
+    mock_sqs_service.is_fifo_queue.return_value = False
+    mock_sqs_service.SQS_SENT = "SENT"
+    mock_sqs_service.send_message.return_value = "SENT"
+    mock_dependencies['ddb'].query_staging_table.return_value.append(
+        _outbox('sent', message_sids=('SM1',), combined_body='Hello', twilio_response={'message_sid': 'SM_earlier', 'body': 'x'}))
+
+    response = index.handler(mock_sqs_event, mock_lambda_context)
+
+    assert response == {"batchItemFailures": []}
+    assert mock_dependencies['ddb'].update_conversation_after_reply.call_args.kwargs['user_message_map']['content'] == 'Hello'
+    keys = mock_dependencies['ddb'].cleanup_staging_table.call_args.args[0]
+    assert [key['message_sid'] for key in keys] == ['SM1', 'outbox#SM1']
+    mock_sqs_service.send_message.assert_called_once_with(
+        'mock-queue-url', {'conversation_id': 'conv_test_123', 'primary_channel': 'user_num_123'})
+
 def test_handler_heartbeat_error(mock_sqs_event, mock_lambda_context, mock_dependencies):
     """Test when the SQS heartbeat fails in the finally block."""
     mock_dependencies['heartbeat_instance'].check_for_errors.return_value = Exception("Heartbeat died")
@@ -481,3 +697,117 @@ def test_handler_multiple_records_mixed_results(mock_lambda_context, mock_depend
     # Check final release was NOT called for either message
     mock_dependencies['ddb'].release_lock_for_retry.assert_not_called()
 
+
+# --- Concurrency Cap Tests ---
+
+def _capped_conversation(mock_dependencies, limit=2):
+    item = mock_dependencies['ddb'].get_conversation_item.return_value
+    item.update({'company_id': 'ci-1', 'project_id': 'pi-1', 'rate_limits': {'concurrent_conversations': limit}})
+    mock_dependencies['ddb'].SEMAPHORE_ACQUIRED = "SEMAPHORE_ACQUIRED"
+    mock_dependencies['ddb'].SEMAPHORE_FULL = "SEMAPHORE_FULL"
+
+def test_handler_holds_and_releases_concurrency_slot(mock_sqs_event, mock_lambda_context, mock_dependencies):
+    """A slot is taken after hydration and given back once the record finishes."""
+    _capped_conversation(mock_dependencies)
+    mock_dependencies['ddb'].acquire_concurrency_slot.return_value = "SEMAPHORE_ACQUIRED"
+
+    response = index.handler(mock_sqs_event, mock_lambda_context)
+
+    assert response == {"batchItemFailures": []}
+    mock_dependencies['ddb'].acquire_concurrency_slot.assert_called_once_with('ci-1', 'pi-1', 'conv_test_123', 2)
+    mock_dependencies['ddb'].release_concurrency_slot.assert_called_once_with('ci-1', 'pi-1', 'conv_test_123')
+    mock_dependencies['twilio'].send_whatsapp_reply.assert_called_once()
+
+@patch('src.messaging_lambda.whatsapp.lambda_pkg.index.sqs_service')
+def test_handler_over_concurrency_cap_defers_record(mock_sqs_service, mock_sqs_event, mock_lambda_context, mock_dependencies):
+    """Over the cap: the record is put back via its visibility timeout and the processing lock released."""
+    _capped_conversation(mock_dependencies)
+    mock_dependencies['ddb'].acquire_concurrency_slot.return_value = "SEMAPHORE_FULL"
+    mock_sqs_service.SQS_REQUEUED = "REQUEUED"
+    mock_sqs_service.defer_message.return_value = "DEFERRED"
+
+    response = index.handler(mock_sqs_event, mock_lambda_context)
+
+    assert response == {"batchItemFailures": [{"itemIdentifier": "msg1"}]}
+    mock_sqs_service.defer_message.assert_called_once_with('mock-queue-url', 'handle1', ANY, 1, ANY)
+    delay = mock_sqs_service.defer_message.call_args.args[4]
+    assert index.CONCURRENCY_DEFER_SECONDS <= delay <= index.CONCURRENCY_DEFER_SECONDS + index.CONCURRENCY_DEFER_JITTER_SECONDS
+    mock_dependencies['heartbeat_instance'].stop.assert_called()
+    mock_dependencies['sm'].get_secret.assert_not_called()
+    mock_dependencies['openai'].process_reply_with_ai.assert_not_called()
+    mock_dependencies['ddb'].release_lock_for_retry.assert_called_once_with('user_num_123', 'conv_test_123')
+    mock_dependencies['ddb'].release_concurrency_slot.assert_not_called()
+
+@patch('src.messaging_lambda.whatsapp.lambda_pkg.index.sqs_service')
+def test_handler_requeued_record_is_not_reported(mock_sqs_service, mock_sqs_event, mock_lambda_context, mock_dependencies):
+    """When a delayed copy was sent instead, the original is acknowledged."""
+    _capped_conversation(mock_dependencies)
+    mock_sqs_event['Records'][0]['attributes'] = {'ApproximateReceiveCount': '2'}
+    mock_dependencies['ddb'].acquire_concurrency_slot.return_value = "SEMAPHORE_FULL"
+    mock_sqs_service.SQS_REQUEUED = "REQUEUED"
+    mock_sqs_service.defer_message.return_value = "REQUEUED"
+
+    response = index.handler(mock_sqs_event, mock_lambda_context)
+
+    assert response == {"batchItemFailures": []}
+    assert mock_sqs_service.defer_message.call_args.args[3] == 2
+    mock_dependencies['ddb'].release_lock_for_retry.assert_called_once()
+
+
+# --- FIFO Queue Tests ---
+
+def _fifo_record(message_id, deadline_ms=None, group_id='conv_test_123'):
+    body = {'conversation_id': 'conv_test_123', 'primary_channel': 'user_num_123'}
+    if deadline_ms is not None:
+        body['batch_deadline_ms'] = deadline_ms
+    return {
+        'messageId': message_id,
+        'receiptHandle': f'handle-{message_id}',
+        'body': json.dumps(body),
+        'attributes': {'ApproximateReceiveCount': '1', 'MessageGroupId': group_id},
+    }
+
+def test_fifo_trigger_waits_out_short_batch_window(mock_lambda_context, mock_dependencies, monkeypatch):
+    """A trigger that arrives just before its batch deadline waits inline, and there is no trigger lock to clean up."""
+    monkeypatch.setenv('WHATSAPP_QUEUE_URL', 'mock-queue-url.fifo')
+    event = {'Records': [_fifo_record('msg1', deadline_ms=1700000000000 + 2000)]}
+
+    with patch('src.messaging_lambda.whatsapp.lambda_pkg.index.time.sleep') as mock_sleep:
+        response = index.handler(event, mock_lambda_context)
+
+    assert response == {"batchItemFailures": []}
+    mock_sleep.assert_called_once_with(2.0)
+    mock_dependencies['twilio'].send_whatsapp_reply.assert_called_once()
+    mock_dependencies['ddb'].cleanup_staging_table.assert_called_once()
+    mock_dependencies['ddb'].cleanup_trigger_lock.assert_not_called()
+
+@patch('src.messaging_lambda.whatsapp.lambda_pkg.index.sqs_service')
+def test_fifo_trigger_deferred_until_batch_deadline(mock_sqs_service, mock_lambda_context, mock_dependencies, monkeypatch):
+    """A trigger far ahead of its deadline is hidden until then, before any lock is taken."""
+    monkeypatch.setenv('WHATSAPP_QUEUE_URL', 'mock-queue-url.fifo')
+    mock_sqs_service.is_fifo_queue.return_value = True
+    mock_sqs_service.SQS_REQUEUED = "REQUEUED"
+    mock_sqs_service.defer_message.return_value = "DEFERRED"
+    event = {'Records': [_fifo_record('msg1', deadline_ms=1700000000000 + 12500)]}
+
+    response = index.handler(event, mock_lambda_context)
+
+    assert response == {"batchItemFailures": [{"itemIdentifier": "msg1"}]}
+    mock_sqs_service.defer_message.assert_called_once_with('mock-queue-url.fifo', 'handle-msg1', ANY, 1, 13)
+    mock_dependencies['ddb'].acquire_processing_lock.assert_not_called()
+
+def test_fifo_failure_fails_rest_of_message_group(mock_lambda_context, mock_dependencies, monkeypatch):
+    """After a record fails, later records of its message group are failed unprocessed; other groups carry on."""
+    monkeypatch.setenv('WHATSAPP_QUEUE_URL', 'mock-queue-url.fifo')
+    mock_dependencies['ddb'].acquire_processing_lock.side_effect = ["DB_ERROR", "ACQUIRED"]
+    event = {'Records': [
+        _fifo_record('msg1', group_id='group-a'),
+        _fifo_record('msg2', group_id='group-a'),
+        _fifo_record('msg3', group_id='group-b'),
+    ]}
+
+    response = index.handler(event, mock_lambda_context)
+
+    assert response == {"batchItemFailures": [{"itemIdentifier": "msg1"}, {"itemIdentifier": "msg2"}]}
+    assert mock_dependencies['ddb'].acquire_processing_lock.call_count == 2
+    mock_dependencies['twilio'].send_whatsapp_reply.assert_called_once()
@@ -0,0 +1,201 @@
+import pytest
+import json
+import os
+import signal
+import threading
+import time
+from unittest.mock import patch, MagicMock
+
+from src.messaging_lambda.whatsapp.lambda_pkg import worker
+
+QUEUE_URL = 'https://sqs.eu-north-1.amazonaws.com/123/whatsapp-queue'
+
+# --- Helpers & Fixtures ---
+
+def sqs_message(message_id, conversation_id='conv_1', group_id=None):
+    message = {
+        'MessageId': message_id,
+        'ReceiptHandle': f"handle-{message_id}",
+        'MD5OfBody': '...',
+        'Body': json.dumps({'conversation_id': conversation_id, 'primary_channel': 'user_num_123'}),
+        'Attributes': {'ApproximateReceiveCount': '1'},
+    }
+    if group_id:
+        message['Attributes']['MessageGroupId'] = group_id
+    return message
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Condition not met in time")
+        time.sleep(0.01)
+
+@pytest.fixture(autouse=True)
+def fast_worker():
+    """Short idle sleeps, deletes flushed only at shutdown, no heartbeat threads."""
+    with patch.object(worker, 'WORKER_IDLE_SLEEP_SECONDS', 0.005), \
+         patch.object(worker, 'WORKER_DELETE_FLUSH_SECONDS', 3600), \
+         patch.object(worker, 'SQSHeartbeat') as mock_heartbeat:
+        yield mock_heartbeat
+
+@pytest.fixture
+def mock_sqs():
+    """Returns the queued batches from receive_message, then nothing."""
+    sqs = MagicMock()
+    batches = []
+
+    def receive_message(**kwargs):
+        if batches:
+            return {'Messages': batches.pop(0)}
+        time.sleep(0.005)
+        return {}
+
+    sqs.receive_message.side_effect = receive_message
+    sqs.delete_message_batch.side_effect = lambda QueueUrl, Entries: {'Successful': [{'Id': e['Id']} for e in Entries]}
+    sqs.change_message_visibility_batch.return_value = {'Successful': []}
+    sqs.batches = batches
+    return sqs
+
+def released_entries(sqs):
+    return [entry for c in sqs.change_message_visibility_batch.call_args_list for entry in c.kwargs['Entries']]
+
+# --- Test Cases ---
+
+def test_shard_for_keeps_a_conversation_on_one_shard():
+    records = [worker.to_lambda_record(sqs_message(f"m{i}", 'conv_same')) for i in range(5)]
+    assert len({worker.shard_for(r, 8) for r in records}) == 1
+    assert worker.shard_key(records[0]) == 'conv_same'
+
+    fifo = worker.to_lambda_record(sqs_message('m9', 'conv_same', group_id='group_1'))
+    assert worker.shard_key(fifo) == 'group_1'
+
+    unparseable = {'messageId': 'm10', 'body': 'not json', 'attributes': {}}
+    assert worker.shard_key(unparseable) == 'm10'
+
+def test_empty_queue_url_raises():
+    with pytest.raises(ValueError):
+        worker.SQSWorker('', sqs_client=MagicMock())
+
+def test_worker_runs_handler_and_batch_deletes_successes(mock_sqs):
+    mock_sqs.batches.append([sqs_message('m1', 'conv_1'), sqs_message('m2', 'conv_2'),
+                             sqs_message('m3', 'conv_3')])
+
+    def handler(event, context):
+        record = event['Records'][0]
+        assert 0 < context.get_remaining_time_in_millis() <= worker.WORKER_RECORD_TIMEOUT_MS
+        if record['messageId'] == 'm2':
+            return {'batchItemFailures': [{'itemIdentifier': 'm2'}]}
+        if record['messageId'] == 'm3':
+            raise RuntimeError("boom")
+        return {'batchItemFailures': []}
+
+    sqs_worker = worker.SQSWorker(QUEUE_URL, handler=handler, concurrency=3, sqs_client=mock_sqs)
+    sqs_worker.start()
+    wait_until(lambda: sqs_worker.stats['succeeded'] + sqs_worker.stats['failed'] == 3)
+    sqs_worker.stop()
+    stats = sqs_worker.wait()
+
+    assert stats == {'received': 3, 'succeeded': 1, 'failed': 2, 'released': 0, 'deleted': 1}
+    receive_kwargs = mock_sqs.receive_message.call_args_list[0].kwargs
+    assert receive_kwargs['WaitTimeSeconds'] == worker.WORKER_WAIT_SECONDS
+    assert receive_kwargs['MaxNumberOfMessages'] == worker.WORKER_MAX_MESSAGES
+    mock_sqs.delete_message_batch.assert_called_once_with(
+        QueueUrl=QUEUE_URL, Entries=[{'Id': '0', 'ReceiptHandle': 'handle-m1'}])
+
+def test_queued_records_keep_a_heartbeat_until_their_shard_runs_them(mock_sqs, fast_worker):
+    mock_sqs.batches.append([sqs_message('m1')])
+    handler = MagicMock(return_value={'batchItemFailures': []})
+    sqs_worker = worker.SQSWorker(QUEUE_URL, handler=handler, concurrency=1, sqs_client=mock_sqs)
+    sqs_worker.start()
+    wait_until(lambda: handler.called)
+    sqs_worker.stop()
+    sqs_worker.wait()
+
+    assert fast_worker.call_args.kwargs['receipt_handle'] == 'handle-m1'
+    fast_worker.return_value.start.assert_called_once()
+    fast_worker.return_value.stop.assert_called_once()
+
+def test_stop_releases_records_not_yet_started(mock_sqs):
+    mock_sqs.batches.append([sqs_message('m1', 'conv_1'), sqs_message('m2', 'conv_2'),
+                             sqs_message('m3', 'conv_3')])
+    started = threading.Event()
+    sqs_worker = None
+
+    def handler(event, context):
+        started.set()
+        sqs_worker.stop()
+        return {'batchItemFailures': []}
+
+    sqs_worker = worker.SQSWorker(QUEUE_URL, handler=handler, concurrency=1, sqs_client=mock_sqs)
+    stats = sqs_worker.run()
+
+    assert started.is_set()
+    assert stats['succeeded'] == 1 and stats['released'] == 2 and stats['deleted'] == 1
+    released = released_entries(mock_sqs)
+    assert sorted(e['ReceiptHandle'] for e in released) == ['handle-m2', 'handle-m3']
+    assert all(e['VisibilityTimeout'] == 0 for e in released)
+
+def test_fifo_group_records_after_a_failure_are_given_back(mock_sqs):
+    mock_sqs.batches.append([sqs_message('m1', group_id='group_1'), sqs_message('m2', group_id='group_1'),
+                             sqs_message('m3', 'conv_other', group_id='group_2')])
+    handler = MagicMock(side_effect=lambda event, context: {
+        'batchItemFailures': [{'itemIdentifier': 'm1'}] if event['Records'][0]['messageId'] == 'm1' else []})
+
+    sqs_worker = worker.SQSWorker(QUEUE_URL, handler=handler, concurrency=1, sqs_client=mock_sqs)
+    sqs_worker.start()
+    wait_until(lambda: sum(sqs_worker.stats[k] for k in ('succeeded', 'failed', 'released')) == 3)
+    sqs_worker.stop()
+    stats = sqs_worker.wait()
+
+    assert [c.args[0]['Records'][0]['messageId'] for c in handler.call_args_list] == ['m1', 'm3']
+    assert [e['ReceiptHandle'] for e in released_entries(mock_sqs)] == ['handle-m2']
+    assert stats['failed'] == 1 and stats['released'] == 1 and stats['deleted'] == 1
+    # Nothing of group_1 received before the failure is left, so the group is forgotten
+    assert sqs_worker._failed_groups == {}
+
+def test_failed_group_without_queued_records_is_not_kept(mock_sqs):
+    mock_sqs.batches.append([sqs_message('m1', group_id='group_1')])
+    handler = MagicMock(return_value={'batchItemFailures': [{'itemIdentifier': 'm1'}]})
+    sqs_worker = worker.SQSWorker(QUEUE_URL, handler=handler, concurrency=1, sqs_client=mock_sqs)
+    sqs_worker.start()
+    wait_until(lambda: sqs_worker.stats['failed'] == 1)
+    sqs_worker.stop()
+    sqs_worker.wait()
+
+    assert sqs_worker._failed_groups == {}
+
+def test_worker_context_counts_down_its_own_deadline():
+    with patch.object(worker.time, 'monotonic', return_value=100.0) as mock_monotonic:
+        first = worker._WorkerContext(timeout_ms=60000)
+        mock_monotonic.return_value = 130.0
+        second = worker._WorkerContext(timeout_ms=60000)
+        assert first.get_remaining_time_in_millis() == 30000
+        assert second.get_remaining_time_in_millis() == 60000
+        mock_monotonic.return_value = 200.0
+        assert first.get_remaining_time_in_millis() == 0
+
+def test_max_in_flight_limits_receive_size(mock_sqs):
+    sqs_worker = worker.SQSWorker(QUEUE_URL, handler=MagicMock(), concurrency=1, max_in_flight=3,
+                                  sqs_client=mock_sqs)
+    sqs_worker.start()
+    wait_until(lambda: mock_sqs.receive_message.called)
+    sqs_worker.stop()
+    sqs_worker.wait()
+    assert mock_sqs.receive_message.call_args_list[0].kwargs['MaxNumberOfMessages'] == 3
+
+def test_sigterm_stops_the_worker():
+    sqs_worker = worker.SQSWorker(QUEUE_URL, handler=MagicMock(), sqs_client=MagicMock())
+    previous = {s: signal.getsignal(s) for s in (signal.SIGTERM, signal.SIGINT)}
+    try:
+        worker.install_signal_handlers(sqs_worker)
+        os.kill(os.getpid(), signal.SIGTERM)
+        wait_until(lambda: sqs_worker.stopping)
+    finally:
+        for signum, handler in previous.items():
+            signal.signal(signum, handler)
+    assert sqs_worker.stopping
+
+def test_main_requires_queue_url(monkeypatch):
+    monkeypatch.delenv('WHATSAPP_QUEUE_URL', raising=False)
+    assert worker.main() == 1
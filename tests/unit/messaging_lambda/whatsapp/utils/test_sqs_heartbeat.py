@@ -6,6 +6,7 @@ from botocore.exceptions import ClientError
 
 # Use the correct absolute import path based on project structure
 from src.messaging_lambda.whatsapp.lambda_pkg.utils.sqs_heartbeat import SQSHeartbeat, DEFAULT_VISIBILITY_TIMEOUT_EXTENSION_SEC
+from src.messaging_lambda.whatsapp.lambda_pkg.utils import retry_policy
 
 # --- Fixtures ---
 
@@ -13,7 +14,7 @@ from src.messaging_lambda.whatsapp.lambda_pkg.utils.sqs_heartbeat import SQSHear
 def mock_boto_client():
     """Provides a mock boto3 SQS client."""
     mock_client = MagicMock()
-    with patch('src.messaging_lambda.whatsapp.lambda_pkg.utils.sqs_heartbeat.boto3.client') as mock_boto_constructor:
+    with patch('src.messaging_lambda.whatsapp.lambda_pkg.utils.sqs_heartbeat.aws_clients.client') as mock_boto_constructor:
         mock_boto_constructor.return_value = mock_client
         yield mock_client
 
@@ -128,6 +129,27 @@ def test_run_loop_stops_on_client_error(mock_event_constructor, heartbeat_instan
     assert heartbeat_instance.check_for_errors() == test_exception
     assert heartbeat_instance._running is False # Check running flag updated
 
+@patch('src.messaging_lambda.whatsapp.lambda_pkg.utils.retry_policy.time.sleep')
+def test_run_loop_survives_a_throttle(mock_sleep, heartbeat_instance):
+    """A throttled extension is retried in-process instead of stopping the heartbeat."""
+    mock_client = heartbeat_instance._sqs_client
+    mock_event = MagicMock()
+    mock_event.wait.side_effect = [False, False, True]
+    heartbeat_instance._stop_event = mock_event
+
+    throttle = ClientError({'Error': {'Code': 'RequestThrottled'}}, 'ChangeMessageVisibility')
+    mock_client.change_message_visibility.side_effect = [throttle, {}, {}]
+
+    with patch.object(retry_policy, 'RETRY_ENABLED', True), \
+         patch.object(retry_policy, '_state', threading.local()):
+        heartbeat_instance._run()
+
+    assert mock_client.change_message_visibility.call_count == 3 # First beat retried once, then the second beat
+    mock_sleep.assert_called_once()
+    mock_event.set.assert_not_called()
+    assert heartbeat_instance.check_for_errors() is None
+    assert heartbeat_instance._running is False
+
 @patch('src.messaging_lambda.whatsapp.lambda_pkg.utils.sqs_heartbeat.threading.Event')
 def test_run_loop_stops_on_unexpected_error(mock_event_constructor, heartbeat_instance):
     """Test the _run loop stops and records error on unexpected Exception."""
@@ -0,0 +1,100 @@
+import pytest
+from unittest.mock import patch
+
+from src.staging_lambda.lambda_pkg.core import admission_controller
+
+NOW = 1700000000.0
+
+# --- Fixtures ---
+
+@pytest.fixture(autouse=True)
+def clean_state():
+    admission_controller.reset_local_state()
+    yield
+    admission_controller.reset_local_state()
+
+@pytest.fixture
+def mock_time():
+    with patch('src.staging_lambda.lambda_pkg.core.admission_controller.time.time', return_value=NOW) as mock:
+        yield mock
+
+@pytest.fixture
+def mock_random():
+    with patch('src.staging_lambda.lambda_pkg.core.admission_controller.random.random', return_value=0.0) as mock:
+        yield mock
+
+def _record(calls, throttled, latency_ms=5.0):
+    for i in range(calls):
+        admission_controller.record('dynamodb', i < throttled, latency_ms)
+
+# --- Test Cases ---
+
+def test_normal_without_enough_samples(mock_time, mock_random):
+    _record(admission_controller.ADMISSION_MIN_SAMPLES - 1, admission_controller.ADMISSION_MIN_SAMPLES - 1)
+    result = admission_controller.admit('whatsapp')
+    assert result == {'admitted': True, 'state': 'normal', 'pressure': 0.0, 'window_extension_seconds': 0}
+
+def test_throttling_degrades_then_sheds(mock_time, mock_random):
+    # 15% throttled = pressure 0.75 against the default 20% shed rate
+    _record(100, 15)
+    result = admission_controller.admit('whatsapp')
+    assert result['admitted'] is True
+    assert result['state'] == 'degraded'
+    assert result['pressure'] == pytest.approx(0.75)
+    assert result['window_extension_seconds'] == round(admission_controller.ADMISSION_MAX_WINDOW_EXTENSION_SECONDS * 0.5)
+
+    _record(100, 100)
+    result = admission_controller.admit('whatsapp')
+    assert result['admitted'] is False
+    assert result['error_code'] == 'OVERLOADED'
+    assert result['state'] == 'shedding'
+
+def test_shedding_is_never_total(mock_time, mock_random):
+    _record(100, 100)
+    mock_random.return_value = admission_controller.ADMISSION_MAX_SHED_FRACTION
+    assert admission_controller.admit('whatsapp')['admitted'] is True
+
+def test_slow_dependencies_raise_pressure(mock_time, mock_random):
+    _record(50, 0, latency_ms=admission_controller.ADMISSION_SHED_LATENCY_MS * 2)
+    assert admission_controller.admit('whatsapp')['admitted'] is False
+
+def test_old_outcomes_leave_the_window(mock_time, mock_random):
+    _record(100, 100)
+    mock_time.return_value = NOW + admission_controller.ADMISSION_WINDOW_SECONDS
+    assert admission_controller.admit('whatsapp')['state'] == 'normal'
+
+def test_track_records_status_and_exceptions(mock_time):
+    with patch.object(admission_controller, 'record') as mock_record:
+        with admission_controller.track('sqs') as call:
+            call.status = 'SQS_TRANSIENT_ERROR'
+        with admission_controller.track('dynamodb') as call:
+            call.status = 'SUCCESS'
+        with pytest.raises(RuntimeError):
+            with admission_controller.track('dynamodb'):
+                raise RuntimeError("boom")
+
+    assert [c.args[:2] for c in mock_record.call_args_list] == [('sqs', True), ('dynamodb', False), ('dynamodb', True)]
+
+def test_queue_depth_is_cached(mock_time, mock_random):
+    with patch.object(admission_controller, 'ADMISSION_SHED_QUEUE_DEPTH', 100), \
+         patch('src.staging_lambda.lambda_pkg.core.admission_controller.sqs_service.get_queue_depth', return_value=80) as mock_depth:
+        first = admission_controller.admit('whatsapp')
+        second = admission_controller.admit('whatsapp')
+        mock_time.return_value = NOW + admission_controller.QUEUE_DEPTH_REFRESH_SECONDS
+        admission_controller.admit('whatsapp')
+
+    assert first['state'] == second['state'] == 'degraded'
+    assert first['pressure'] == pytest.approx(0.8)
+    assert mock_depth.call_count == 2
+    mock_depth.assert_called_with(admission_controller.routing.WHATSAPP_QUEUE_URL)
+
+def test_unreadable_queue_depth_is_ignored(mock_time, mock_random):
+    with patch.object(admission_controller, 'ADMISSION_SHED_QUEUE_DEPTH', 100), \
+         patch('src.staging_lambda.lambda_pkg.core.admission_controller.sqs_service.get_queue_depth', return_value=None):
+        assert admission_controller.admit('whatsapp')['state'] == 'normal'
+
+def test_disabled_admits_everything(mock_time, mock_random):
+    with patch.object(admission_controller, 'ADMISSION_CONTROL_ENABLED', False):
+        _record(100, 100)
+        assert admission_controller.admit('whatsapp')['admitted'] is True
+    assert admission_controller._buckets == {}
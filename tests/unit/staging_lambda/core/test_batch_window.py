@@ -0,0 +1,65 @@
+import pytest
+from unittest.mock import patch
+
+from src.staging_lambda.lambda_pkg.core import batch_window
+
+# --- looks_complete Tests ---
+
+@pytest.mark.parametrize("body, expected", [
+    ("Can you send me the invoice?", True),
+    ("Thanks!", True),
+    ("ok", True),
+    ("I was wondering,", False),
+    ("Also I need the address and", False),
+    ("Let me think...", False),
+    ("hang on", False),
+    ("", False),
+    (None, False),
+])
+def test_looks_complete(body, expected):
+    assert batch_window.looks_complete(body) is expected
+
+# --- summarize_stats Tests ---
+
+def test_summarize_stats_empty():
+    stats = batch_window.summarize_stats(None)
+    assert stats == {'batches': 0, 'mean_gap_seconds': None, 'fragments_per_batch': None, 'split_rate': 0.0}
+
+def test_summarize_stats_counters():
+    stats = batch_window.summarize_stats({
+        'batch_count': 4, 'fragment_count': 10, 'gap_sum_ms': 12000, 'gap_count': 6, 'split_count': 1
+    })
+    assert stats['batches'] == 4
+    assert stats['mean_gap_seconds'] == pytest.approx(2.0)
+    assert stats['fragments_per_batch'] == pytest.approx(2.5)
+    assert stats['split_rate'] == pytest.approx(0.25)
+
+# --- choose_delay_seconds Tests ---
+
+def test_choose_delay_cold_start_uses_default_window():
+    assert batch_window.choose_delay_seconds("I wanted to ask,", {}) == batch_window.BATCH_WINDOW_SECONDS
+
+def test_choose_delay_cold_start_complete_message_flushes_early():
+    assert batch_window.choose_delay_seconds("What time do you open?", {}) == batch_window.EARLY_FLUSH_SECONDS
+
+def test_choose_delay_single_fragment_sender_gets_minimum():
+    stats = {'batch_count': 5, 'fragment_count': 5}
+    assert batch_window.choose_delay_seconds("hang on", stats) == batch_window.MIN_BATCH_WINDOW_SECONDS
+
+def test_choose_delay_burst_sender_window_covers_gap():
+    # Mean gap 4s -> 4 * 2.0 + 1 = 9s; complete-looking text must not shorten it for a burst sender
+    stats = {'batch_count': 5, 'fragment_count': 15, 'gap_sum_ms': 40000, 'gap_count': 10}
+    assert batch_window.choose_delay_seconds("First part.", stats) == 9
+
+def test_choose_delay_splits_widen_window():
+    stats = {'batch_count': 4, 'fragment_count': 8, 'gap_sum_ms': 12000, 'gap_count': 4, 'split_count': 2}
+    # Mean gap 3s -> 7s, split rate 0.5 -> ceil(10.5) = 11s
+    assert batch_window.choose_delay_seconds("and", stats) == 11
+
+def test_choose_delay_clamped_to_max():
+    stats = {'batch_count': 3, 'fragment_count': 9, 'gap_sum_ms': 600000, 'gap_count': 6}
+    assert batch_window.choose_delay_seconds("more", stats) == batch_window.MAX_BATCH_WINDOW_SECONDS
+
+def test_choose_delay_disabled_returns_fixed_window():
+    with patch.object(batch_window, 'ADAPTIVE_BATCH_WINDOW_ENABLED', False):
+        assert batch_window.choose_delay_seconds("ok", {'batch_count': 10, 'fragment_count': 10}) == batch_window.BATCH_WINDOW_SECONDS
@@ -0,0 +1,71 @@
+import pytest
+from unittest.mock import patch
+
+from src.staging_lambda.lambda_pkg.core import keyword_rules
+
+RULES = [
+    {'name': 'stop', 'keywords': ['STOP', 'Unsubscribe'], 'action': 'opt_out', 'reply': 'You have been unsubscribed.'},
+    {'keywords': ['help'], 'action': 'reply', 'reply': 'Reply STOP to unsubscribe.'},
+    {'name': 'agent', 'pattern': r'\b(agent|human)\b', 'action': 'handoff'},
+    {'name': 'ack', 'pattern': r'^(ok|okay|thanks?)\W*$', 'action': 'drop', 'reply': 'ignored for drop'},
+]
+
+# --- Helpers & Fixtures ---
+
+def context(body, rules=RULES, project_id='pi-1'):
+    return {'company_id': 'ci-1', 'project_id': project_id, 'body': body, 'keyword_rules': rules}
+
+@pytest.fixture(autouse=True)
+def clean_state():
+    keyword_rules.reset_local_state()
+    yield
+    keyword_rules.reset_local_state()
+
+# --- Test Cases ---
+
+@pytest.mark.parametrize('body, rule, action', [
+    ('STOP', 'stop', 'opt_out'),
+    ('  stop. ', 'stop', 'opt_out'),
+    ('unsubscribe!', 'stop', 'opt_out'),
+    ('Help?', '1', 'reply'),
+    ('Can I talk to a human please', 'agent', 'handoff'),
+    ('Okay!!', 'ack', 'drop'),
+])
+def test_matching_messages(body, rule, action):
+    result = keyword_rules.match(context(body))
+    assert (result['matched'], result['rule'], result['action']) == (True, rule, action)
+
+@pytest.mark.parametrize('body', ['stop sending me the job details', 'ok so what are the hours?', '', None])
+def test_other_messages_go_to_the_ai(body):
+    assert keyword_rules.match(context(body)) == {'matched': False}
+
+def test_first_matching_rule_wins_and_drop_has_no_reply():
+    rules = [{'keywords': ['ok'], 'action': 'drop', 'reply': 'x'}, {'keywords': ['ok'], 'action': 'reply', 'reply': 'y'}]
+    assert keyword_rules.match(context('ok', rules)) == {'matched': True, 'rule': '0', 'action': 'drop', 'reply': None}
+
+def test_invalid_rules_are_skipped():
+    rules = [
+        {'pattern': '(unclosed', 'action': 'drop'},
+        {'keywords': ['stop'], 'action': 'explode'},
+        {'action': 'reply', 'reply': 'nothing to match'},
+        'not a rule',
+        {'keywords': ['stop'], 'action': 'OPT_OUT'},
+    ]
+    compiled = keyword_rules.compile_rules(rules)
+    assert [rule['name'] for rule in compiled] == ['4']
+    assert keyword_rules.match(context('stop', rules))['action'] == 'opt_out'
+
+def test_rules_compiled_once_per_project_until_they_change():
+    with patch.object(keyword_rules, 'compile_rules', wraps=keyword_rules.compile_rules) as compile_rules:
+        for body in ('stop', 'help', 'hello'):
+            keyword_rules.match(context(body))
+        assert compile_rules.call_count == 1
+
+        keyword_rules.match(context('stop', project_id='pi-2'))
+        keyword_rules.match(context('stop', RULES[1:]))
+        assert compile_rules.call_count == 3
+
+def test_long_messages_and_disabled_rules_are_not_matched():
+    assert keyword_rules.match(context('stop ' * 100 + 'human')) == {'matched': False}
+    with patch.object(keyword_rules, 'KEYWORD_RULES_ENABLED', False):
+        assert keyword_rules.match(context('STOP')) == {'matched': False}
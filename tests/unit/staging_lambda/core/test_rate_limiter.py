@@ -0,0 +1,138 @@
+import pytest
+from unittest.mock import patch
+
+from src.staging_lambda.lambda_pkg.core import rate_limiter
+
+NOW = 1700000000.0 # minute bucket 28333333, day bucket 19675
+
+# --- Fixtures ---
+
+@pytest.fixture(autouse=True)
+def clean_buckets():
+    rate_limiter.reset_local_state()
+    yield
+    rate_limiter.reset_local_state()
+
+@pytest.fixture
+def mock_reserve():
+    with patch('src.staging_lambda.lambda_pkg.core.rate_limiter.dynamodb_service.reserve_rate_limit_tokens') as mock:
+        mock.return_value = {'status': 'RESERVED', 'count': 1}
+        yield mock
+
+@pytest.fixture
+def mock_time():
+    with patch('src.staging_lambda.lambda_pkg.core.rate_limiter.time.time', return_value=NOW) as mock:
+        yield mock
+
+def _context(per_minute=0, per_day=0, company_id='ci-aaa-000'):
+    return {'company_id': company_id, 'rate_limits': {'requests_per_minute': per_minute, 'requests_per_day': per_day}}
+
+# --- Test Cases ---
+
+def test_no_limits_configured_skips_counters(mock_reserve):
+    assert rate_limiter.check_rate_limit(_context()) == {'valid': True}
+    assert rate_limiter.check_rate_limit({'rate_limits': {'requests_per_minute': 5}}) == {'valid': True} # no company_id
+    mock_reserve.assert_not_called()
+
+def test_resolve_limits_falls_back_to_defaults():
+    with patch.object(rate_limiter, 'DEFAULT_REQUESTS_PER_DAY', 500):
+        limits = rate_limiter.resolve_limits({'rate_limits': {'requests_per_minute': '60'}})
+    assert limits == {'requests_per_minute': 60, 'requests_per_day': 500}
+
+def test_lease_is_spent_locally(mock_reserve, mock_time):
+    """One round trip per counter reserves a lease; the rest of it needs no DynamoDB call."""
+    context = _context(per_minute=600, per_day=20000) # lease = min(10, 600 // 20, 20000 // 20) = 10
+    for _ in range(10):
+        assert rate_limiter.check_rate_limit(context)['valid'] is True
+    assert mock_reserve.call_count == 2
+    mock_reserve.assert_any_call('ratelimit#ci-aaa-000#m#28333333', 10, 600, 28333334 * 60 + 300)
+    mock_reserve.assert_any_call('ratelimit#ci-aaa-000#d#19675', 10, 20000, 19676 * 86400 + 300)
+
+    rate_limiter.check_rate_limit(context)
+    assert mock_reserve.call_count == 4
+
+def test_new_minute_discards_leftover_tokens(mock_reserve, mock_time):
+    context = _context(per_minute=600)
+    rate_limiter.check_rate_limit(context)
+    mock_time.return_value = NOW + 60
+    rate_limiter.check_rate_limit(context)
+    assert [c.args[0] for c in mock_reserve.call_args_list] == [
+        'ratelimit#ci-aaa-000#m#28333333', 'ratelimit#ci-aaa-000#m#28333334'
+    ]
+
+def test_partial_room_falls_back_to_single_token(mock_reserve, mock_time):
+    mock_reserve.side_effect = [{'status': 'LIMIT_EXCEEDED'}, {'status': 'RESERVED', 'count': 600}]
+    assert rate_limiter.check_rate_limit(_context(per_minute=600))['valid'] is True
+    assert [c.args[1] for c in mock_reserve.call_args_list] == [10, 1]
+
+def test_over_limit_is_rejected_and_cached_until_bucket_ends(mock_reserve, mock_time):
+    mock_reserve.return_value = {'status': 'LIMIT_EXCEEDED'}
+    context = _context(per_minute=60)
+
+    result = rate_limiter.check_rate_limit(context)
+    assert result['valid'] is False
+    assert result['error_code'] == 'RATE_LIMITED'
+    calls = mock_reserve.call_count
+
+    # Rejected locally for the rest of the minute
+    mock_time.return_value = NOW + 10
+    assert rate_limiter.check_rate_limit(context)['valid'] is False
+    assert mock_reserve.call_count == calls
+
+    mock_time.return_value = NOW + 60
+    mock_reserve.return_value = {'status': 'RESERVED', 'count': 3}
+    assert rate_limiter.check_rate_limit(context)['valid'] is True
+
+def test_day_limit_gives_back_the_minute_tokens(mock_time):
+    """A request over the daily limit leaves the minute counter where it was."""
+    counters = {'ratelimit#ci-aaa-000#d#19675': 20000}
+
+    def reserve(key, amount, limit, expires_at):
+        if counters.get(key, 0) + amount > limit:
+            return {'status': 'LIMIT_EXCEEDED'}
+        counters[key] = counters.get(key, 0) + amount
+        return {'status': 'RESERVED', 'count': counters[key]}
+
+    def release(key, amount):
+        counters[key] -= amount
+        return True
+
+    with patch.object(rate_limiter.dynamodb_service, 'reserve_rate_limit_tokens', side_effect=reserve) as mock_reserve, \
+            patch.object(rate_limiter.dynamodb_service, 'release_rate_limit_tokens', side_effect=release) as mock_release:
+        assert rate_limiter.check_rate_limit(_context(per_minute=600, per_day=20000))['valid'] is False
+
+    assert [c.args[:2] for c in mock_reserve.call_args_list] == [
+        ('ratelimit#ci-aaa-000#m#28333333', 10), ('ratelimit#ci-aaa-000#d#19675', 10), ('ratelimit#ci-aaa-000#d#19675', 1)
+    ]
+    mock_release.assert_called_once_with('ratelimit#ci-aaa-000#m#28333333', 10)
+    assert counters['ratelimit#ci-aaa-000#m#28333333'] == 0
+
+def test_steady_low_rate_is_not_blocked_by_lapsed_minute_leases(mock_time):
+    """One message a minute for a whole day stays allowed: unused minute tokens don't use up the day."""
+    counters = {}
+
+    def reserve(key, amount, limit, expires_at):
+        if counters.get(key, 0) + amount > limit:
+            return {'status': 'LIMIT_EXCEEDED'}
+        counters[key] = counters.get(key, 0) + amount
+        return {'status': 'RESERVED', 'count': counters[key]}
+
+    day_start = (int(NOW) // 86400) * 86400
+    context = _context(per_minute=60, per_day=2000) # minute lease 3, day lease 10
+    with patch.object(rate_limiter.dynamodb_service, 'reserve_rate_limit_tokens', side_effect=reserve):
+        allowed = 0
+        for minute in range(1440):
+            mock_time.return_value = day_start + minute * 60 + 1
+            allowed += rate_limiter.check_rate_limit(context)['valid']
+
+    assert allowed == 1440
+    assert counters[f"ratelimit#ci-aaa-000#d#{day_start // 86400}"] == 1440
+
+def test_counter_errors_fail_open(mock_reserve, mock_time):
+    mock_reserve.return_value = {'status': 'RATE_LIMIT_DB_TRANSIENT_ERROR'}
+    assert rate_limiter.check_rate_limit(_context(per_minute=60)) == {'valid': True}
+
+def test_companies_are_limited_independently(mock_reserve, mock_time):
+    mock_reserve.side_effect = lambda key, *args: {'status': 'LIMIT_EXCEEDED'} if 'noisy' in key else {'status': 'RESERVED', 'count': 1}
+    assert rate_limiter.check_rate_limit(_context(per_minute=60, company_id='noisy'))['valid'] is False
+    assert rate_limiter.check_rate_limit(_context(per_minute=60, company_id='quiet'))['valid'] is True
@@ -0,0 +1,79 @@
+import pytest
+from unittest.mock import patch
+
+from src.staging_lambda.lambda_pkg.core import sender_filter
+
+NOW = 1700000000.0
+
+# --- Fixtures ---
+
+@pytest.fixture(autouse=True)
+def clean_state():
+    sender_filter.reset_local_state()
+    yield
+    sender_filter.reset_local_state()
+
+@pytest.fixture
+def mock_time():
+    with patch('src.staging_lambda.lambda_pkg.core.sender_filter.time.time', return_value=NOW) as mock:
+        yield mock
+
+@pytest.fixture
+def mock_identifiers():
+    with patch('src.staging_lambda.lambda_pkg.core.sender_filter.company_config_service.load_company_identifiers') as mock:
+        mock.return_value = {'whatsapp': {'+447000000000'}, 'sms': set(), 'email': set()}
+        yield mock
+
+# --- Test Cases ---
+
+def test_unknown_sender_allowed_until_recorded(mock_time):
+    assert sender_filter.check_sender('whatsapp', 'whatsapp:+1', 'whatsapp:+2') == {'valid': True}
+    sender_filter.record_not_found('whatsapp', 'whatsapp:+1', 'whatsapp:+2')
+
+    result = sender_filter.check_sender('whatsapp', 'whatsapp:+1', 'whatsapp:+2')
+    assert result['valid'] is False
+    assert result['error_code'] == 'NOT_FOUND'
+    # Other senders to the same number are unaffected
+    assert sender_filter.check_sender('whatsapp', 'whatsapp:+3', 'whatsapp:+2') == {'valid': True}
+
+def test_entries_expire_after_ttl(mock_time):
+    sender_filter.record_not_found('whatsapp', 'whatsapp:+1', 'whatsapp:+2')
+    mock_time.return_value = NOW + sender_filter.NEGATIVE_CACHE_TTL_SECONDS
+    assert sender_filter.check_sender('whatsapp', 'whatsapp:+1', 'whatsapp:+2') == {'valid': True}
+    assert len(sender_filter._negative_cache) == 0
+
+def test_cache_is_bounded_lru(mock_time):
+    with patch.object(sender_filter, 'NEGATIVE_CACHE_MAX_ENTRIES', 2):
+        sender_filter.record_not_found('whatsapp', '+1', '+9')
+        sender_filter.record_not_found('whatsapp', '+2', '+9')
+        sender_filter.check_sender('whatsapp', '+1', '+9') # Touch +1 so +2 is the oldest
+        sender_filter.record_not_found('whatsapp', '+3', '+9')
+
+    assert sender_filter.check_sender('whatsapp', '+1', '+9')['valid'] is False
+    assert sender_filter.check_sender('whatsapp', '+2', '+9')['valid'] is True
+    assert sender_filter.check_sender('whatsapp', '+3', '+9')['valid'] is False
+
+def test_disabled_negative_cache(mock_time):
+    with patch.object(sender_filter, 'NEGATIVE_CACHE_ENABLED', False):
+        sender_filter.record_not_found('whatsapp', '+1', '+2')
+        assert sender_filter.check_sender('whatsapp', '+1', '+2') == {'valid': True}
+
+def test_known_number_filter_rejects_unknown_company_number(mock_time, mock_identifiers):
+    with patch.object(sender_filter, 'KNOWN_NUMBER_FILTER_ENABLED', True):
+        assert sender_filter.check_sender('whatsapp', 'whatsapp:+1', 'whatsapp:+447000000000') == {'valid': True}
+        assert sender_filter.check_sender('whatsapp', 'whatsapp:+1', 'whatsapp:+449999999999')['valid'] is False
+        mock_time.return_value = NOW + sender_filter.KNOWN_NUMBERS_REFRESH_SECONDS
+        sender_filter.check_sender('whatsapp', 'whatsapp:+1', 'whatsapp:+447000000000')
+    assert mock_identifiers.call_count == 2
+
+def test_known_number_filter_fails_open(mock_time, mock_identifiers):
+    mock_identifiers.return_value = None
+    with patch.object(sender_filter, 'KNOWN_NUMBER_FILTER_ENABLED', True):
+        assert sender_filter.check_sender('whatsapp', '+1', '+449999999999') == {'valid': True}
+
+def test_failed_refresh_keeps_previous_numbers(mock_time, mock_identifiers):
+    with patch.object(sender_filter, 'KNOWN_NUMBER_FILTER_ENABLED', True):
+        sender_filter.check_sender('whatsapp', '+1', '+447000000000')
+        mock_identifiers.return_value = None
+        mock_time.return_value = NOW + sender_filter.KNOWN_NUMBERS_REFRESH_SECONDS
+        assert sender_filter.check_sender('whatsapp', '+1', '+449999999999')['valid'] is False
@@ -77,4 +77,22 @@ def test_validate_rules_conversation_status_missing(valid_context_base):
     context = valid_context_base
     del context['conversation_status']
     result = validate_conversation_rules(context)
-    assert result['valid'] is True # Missing status is not considered locked 
\ No newline at end of file
+    assert result['valid'] is True # Missing status is not considered locked 
+
+
+def test_validate_rules_message_too_long(valid_context_base):
+    """Test failure when the body exceeds the company's max_message_length."""
+    context = valid_context_base
+    context['rate_limits'] = {'max_message_length': 10}
+    context['body'] = 'x' * 11
+    result = validate_conversation_rules(context)
+    assert result['valid'] is False
+    assert result['error_code'] == 'MESSAGE_TOO_LONG'
+
+
+def test_validate_rules_message_at_max_length(valid_context_base):
+    """Test a body exactly at max_message_length passes."""
+    context = valid_context_base
+    context['rate_limits'] = {'max_message_length': 10}
+    context['body'] = 'x' * 10
+    assert validate_conversation_rules(context)['valid'] is True
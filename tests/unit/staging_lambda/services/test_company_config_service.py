@@ -0,0 +1,118 @@
+import pytest
+from unittest.mock import patch, MagicMock
+from botocore.exceptions import ClientError
+
+from src.staging_lambda.lambda_pkg.services import company_config_service
+
+NOW = 1700000000.0
+RECORD = {
+    'company_id': 'ci-aaa-000',
+    'project_id': 'pi-aaa-000',
+    'config_version': 3,
+    'project_status': 'active',
+    'allowed_channels': ['whatsapp'],
+    'rate_limits': {'requests_per_minute': 60},
+    'ai_config': {'openai_config': {'whatsapp': {'api_key_reference': 'openai-ref', 'assistant_id_replies': 'asst_1'}}},
+    'channel_config': {'whatsapp': {'company_whatsapp_number': '+44123', 'whatsapp_credentials_id': 'twilio-ref'}},
+}
+
+# --- Fixtures ---
+
+@pytest.fixture
+def mock_table():
+    table = MagicMock()
+    table.get_item.return_value = {'Item': dict(RECORD)}
+    with patch.object(company_config_service, 'company_data_table', table), \
+         patch.object(company_config_service, '_cache', {}):
+        yield table
+
+@pytest.fixture
+def mock_time():
+    with patch('src.staging_lambda.lambda_pkg.services.company_config_service.time.time', return_value=NOW) as mock:
+        yield mock
+
+# --- Test Cases ---
+
+def test_disabled_without_table():
+    with patch.object(company_config_service, 'company_data_table', None):
+        assert company_config_service.get_company_config('ci-aaa-000', 'pi-aaa-000') == (company_config_service.CONFIG_DISABLED, None)
+
+def test_record_is_cached_within_ttl(mock_table, mock_time):
+    first = company_config_service.get_company_config('ci-aaa-000', 'pi-aaa-000')
+    mock_time.return_value = NOW + company_config_service.COMPANY_CONFIG_CACHE_TTL_SECONDS - 1
+    second = company_config_service.get_company_config('ci-aaa-000', 'pi-aaa-000')
+    assert first == second == (company_config_service.CONFIG_FOUND, RECORD)
+    mock_table.get_item.assert_called_once_with(Key={'company_id': 'ci-aaa-000', 'project_id': 'pi-aaa-000'})
+
+def test_expired_entry_with_same_version_is_revalidated_cheaply(mock_table, mock_time):
+    company_config_service.get_company_config('ci-aaa-000', 'pi-aaa-000')
+    mock_table.get_item.return_value = {'Item': {'config_version': 3}}
+    mock_time.return_value = NOW + company_config_service.COMPANY_CONFIG_CACHE_TTL_SECONDS
+    _, record = company_config_service.get_company_config('ci-aaa-000', 'pi-aaa-000')
+    assert record == RECORD
+    assert mock_table.get_item.call_args.kwargs['ProjectionExpression'] == 'config_version, updated_at'
+    assert mock_table.get_item.call_count == 2
+
+def test_new_version_reloads_record(mock_table, mock_time):
+    company_config_service.get_company_config('ci-aaa-000', 'pi-aaa-000')
+    updated = dict(RECORD, config_version=4, project_status='paused')
+    mock_table.get_item.side_effect = [{'Item': {'config_version': 4}}, {'Item': updated}]
+    mock_time.return_value = NOW + company_config_service.COMPANY_CONFIG_CACHE_TTL_SECONDS
+    assert company_config_service.get_company_config('ci-aaa-000', 'pi-aaa-000')[1]['project_status'] == 'paused'
+
+def test_edit_without_version_bump_reloads_record(mock_table, mock_time):
+    """An edit that moved updated_at but kept config_version is still picked up."""
+    mock_table.get_item.return_value = {'Item': dict(RECORD, updated_at='2024-01-01T00:00:00+00:00')}
+    company_config_service.get_company_config('ci-aaa-000', 'pi-aaa-000')
+    updated = dict(RECORD, updated_at='2024-02-01T00:00:00+00:00', project_status='paused')
+    mock_table.get_item.side_effect = [{'Item': {'config_version': 3, 'updated_at': updated['updated_at']}}, {'Item': updated}]
+    mock_time.return_value = NOW + company_config_service.COMPANY_CONFIG_CACHE_TTL_SECONDS
+    assert company_config_service.get_company_config('ci-aaa-000', 'pi-aaa-000')[1]['project_status'] == 'paused'
+
+def test_revalidation_error_serves_cached_copy(mock_table, mock_time):
+    company_config_service.get_company_config('ci-aaa-000', 'pi-aaa-000')
+    mock_table.get_item.side_effect = ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Test'}}, 'GetItem')
+    mock_time.return_value = NOW + company_config_service.COMPANY_CONFIG_CACHE_TTL_SECONDS
+    assert company_config_service.get_company_config('ci-aaa-000', 'pi-aaa-000')[0] == company_config_service.CONFIG_FOUND
+
+def test_missing_record_is_cached_as_not_found(mock_table, mock_time):
+    mock_table.get_item.return_value = {}
+    assert company_config_service.get_company_config('ci-new', 'pi-new') == (company_config_service.CONFIG_NOT_FOUND, None)
+    assert company_config_service.get_company_config('ci-new', 'pi-new') == (company_config_service.CONFIG_NOT_FOUND, None)
+    mock_table.get_item.assert_called_once()
+
+def test_load_error_is_not_cached(mock_table, mock_time):
+    mock_table.get_item.side_effect = [
+        ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Test'}}, 'GetItem'),
+        {'Item': dict(RECORD)},
+    ]
+    assert company_config_service.get_company_config('ci-aaa-000', 'pi-aaa-000') == (company_config_service.CONFIG_DB_ERROR, None)
+    assert company_config_service.get_company_config('ci-aaa-000', 'pi-aaa-000') == (company_config_service.CONFIG_FOUND, RECORD)
+
+def test_invalidate_forces_reload(mock_table, mock_time):
+    company_config_service.get_company_config('ci-aaa-000', 'pi-aaa-000')
+    company_config_service.invalidate('ci-aaa-000', 'pi-aaa-000')
+    company_config_service.get_company_config('ci-aaa-000', 'pi-aaa-000')
+    assert mock_table.get_item.call_count == 2
+
+def test_channel_view_flattens_channel_maps():
+    view = company_config_service.channel_view(RECORD, 'whatsapp')
+    assert view['ai_config'] == {'api_key_reference': 'openai-ref', 'assistant_id_replies': 'asst_1'}
+    assert view['channel_config'] == {'company_whatsapp_number': '+44123', 'whatsapp_credentials_id': 'twilio-ref'}
+    assert view['rate_limits'] == {'requests_per_minute': 60}
+    assert 'company_id' not in view and 'config_version' not in view
+    # No settings for the channel - leave the conversation's own copy in place
+    assert 'ai_config' not in company_config_service.channel_view(RECORD, 'email')
+
+def test_load_company_identifiers_paginates(mock_table):
+    mock_table.scan.side_effect = [
+        {'Items': [{'channel_config': RECORD['channel_config']}], 'LastEvaluatedKey': {'company_id': 'x'}},
+        {'Items': [{'channel_config': {'email': {'company_email': 'jobs@example.com'}}}, {}]},
+    ]
+    identifiers = company_config_service.load_company_identifiers()
+    assert identifiers == {'whatsapp': {'+44123'}, 'sms': set(), 'email': {'jobs@example.com'}}
+    assert mock_table.scan.call_args.kwargs['ExclusiveStartKey'] == {'company_id': 'x'}
+
+def test_load_company_identifiers_error_returns_none(mock_table):
+    mock_table.scan.side_effect = ClientError({'Error': {'Code': 'AccessDeniedException', 'Message': 'Test'}}, 'Scan')
+    assert company_config_service.load_company_identifiers() is None
@@ -0,0 +1,114 @@
+import pytest
+from decimal import Decimal, Inexact
+from unittest.mock import MagicMock
+from boto3.dynamodb.types import Binary, TypeSerializer, TypeDeserializer
+
+from src.staging_lambda.lambda_pkg.services import dynamodb_lowlevel
+
+# --- Helpers ---
+
+ITEM = {
+    'conversation_id': 'conv_abc',
+    'received_at_ms': 1700000000000,
+    'ratio': Decimal('0.25'),
+    'task_complete': 0,
+    'hand_off_to_human': False,
+    'hand_off_to_human_reason': None,
+    'channel_config': {'whatsapp_credentials_id': 'secret/ref', 'limits': {'max': 10}},
+    'messages': [{'role': 'user', 'content': 'hi'}, {'role': 'assistant', 'content': 'hello'}],
+    'tags': {'a', 'b'},
+    'counts': {1, 2, Decimal('3.5')},
+    'payload': b'\x00\x01',
+    'blobs': {b'x', b'y'},
+    'empty_map': {},
+    'empty_list': [],
+}
+
+def boto3_marshal(item):
+    serializer = TypeSerializer()
+    return {k: serializer.serialize(v) for k, v in item.items()}
+
+def sort_sets(attribute_values):
+    """Set members have no order on the wire - sort them before comparing."""
+    return {
+        k: {t: sorted(v) if t in ('SS', 'NS', 'BS') else v for t, v in av.items()}
+        for k, av in attribute_values.items()
+    }
+
+# --- Marshalling Tests ---
+
+def test_serialize_matches_boto3():
+    assert sort_sets(dynamodb_lowlevel.serialize_item(ITEM)) == sort_sets(boto3_marshal(ITEM))
+
+def test_deserialize_matches_boto3():
+    deserializer = TypeDeserializer()
+    wire = boto3_marshal(ITEM)
+    expected = {k: deserializer.deserialize(v) for k, v in wire.items()}
+    assert dynamodb_lowlevel.deserialize_item(wire) == expected
+    assert dynamodb_lowlevel.deserialize_item(wire)['received_at_ms'] == Decimal(1700000000000)
+    assert isinstance(dynamodb_lowlevel.deserialize_item(wire)['payload'], Binary)
+
+def test_large_and_subclassed_numbers_match_boto3():
+    class Flag(int):
+        pass
+    for value in [10 ** 37, -(10 ** 37), 10 ** 38 - 1, Decimal('1E+50'), Flag(3), True]:
+        assert dynamodb_lowlevel.serialize(value) == TypeSerializer().serialize(value)
+
+@pytest.mark.parametrize("value", [1.5, {1.5}, Decimal('NaN'), Decimal('Infinity'), object()])
+def test_unsupported_values_are_rejected(value):
+    with pytest.raises(TypeError):
+        dynamodb_lowlevel.serialize(value)
+
+def test_inexact_numbers_are_rejected():
+    with pytest.raises(Inexact):
+        dynamodb_lowlevel.serialize(Decimal('1.' + '1' * 40))
+
+def test_projection_is_cached():
+    expression, names = dynamodb_lowlevel.projection(('conversation_id', 'messages'))
+    assert expression == '#a0, #a1'
+    assert names == {'#a0': 'conversation_id', '#a1': 'messages'}
+    assert dynamodb_lowlevel.projection(('conversation_id', 'messages'))[1] is names
+
+# --- Operation Tests ---
+
+def test_get_item_request_and_result():
+    client = MagicMock()
+    client.get_item.return_value = {'Item': {'conversation_id': {'S': 'c1'}, 'count': {'N': '2'}}}
+    item = dynamodb_lowlevel.get_item(client, 'table', {'conversation_id': 'c1'}, consistent_read=True, attributes=['count'])
+    assert item == {'conversation_id': 'c1', 'count': Decimal(2)}
+    client.get_item.assert_called_once_with(
+        TableName='table',
+        Key={'conversation_id': {'S': 'c1'}},
+        ConsistentRead=True,
+        ProjectionExpression='#a0',
+        ExpressionAttributeNames={'#a0': 'count'}
+    )
+
+def test_get_item_missing_returns_none():
+    client = MagicMock()
+    client.get_item.return_value = {}
+    assert dynamodb_lowlevel.get_item(client, 'table', {'conversation_id': 'c1'}) is None
+
+def test_query_omits_unset_parameters():
+    client = MagicMock()
+    client.query.return_value = {'Items': [{'message_sid': {'S': 's1'}}]}
+    items = dynamodb_lowlevel.query(client, 'table', 'conversation_id = :cid', {':cid': 'c1'})
+    assert items == [{'message_sid': 's1'}]
+    client.query.assert_called_once_with(
+        TableName='table',
+        KeyConditionExpression='conversation_id = :cid',
+        ExpressionAttributeValues={':cid': {'S': 'c1'}}
+    )
+
+def test_update_item_returns_attributes():
+    client = MagicMock()
+    client.update_item.return_value = {'Attributes': {'batch_count': {'N': '4'}}}
+    attributes = dynamodb_lowlevel.update_item(
+        client, 'table', {'conversation_id': 'c1'}, 'SET a = :a',
+        condition='attribute_not_exists(a)', values={':a': 1}, return_values='ALL_OLD'
+    )
+    assert attributes == {'batch_count': 4}
+    assert client.update_item.call_args.kwargs['ExpressionAttributeValues'] == {':a': {'N': '1'}}
+
+    client.update_item.return_value = {}
+    assert dynamodb_lowlevel.update_item(client, 'table', {'conversation_id': 'c1'}, 'SET a = :a', values={':a': 1}) == {}
@@ -3,6 +3,7 @@ import os # Import os
 from unittest.mock import patch, MagicMock, ANY
 from botocore.exceptions import ClientError
 import time
+from decimal import Decimal
 
 # Use the correct absolute import path based on project structure
 from src.staging_lambda.lambda_pkg.services import dynamodb_service
@@ -41,12 +42,18 @@ def mock_dynamodb_resource():
             raise ValueError(f"Unexpected table name passed to boto3.resource.Table: {table_name}")
 
     mock_resource.Table.side_effect = table_side_effect
-
-    # Patch boto3.resource to return our mock resource
-    with patch('src.staging_lambda.lambda_pkg.services.dynamodb_service.boto3.resource') as mock_boto_resource:
+    # Per-request calls go through the plain low-level client (services/dynamodb_lowlevel.py)
+    mock_client = MagicMock(name="DynamoDBClient")
+    mock_conversations_table.name = expected_conversations_table
+    mock_stage_table.name = expected_stage_table
+    mock_lock_table.name = expected_lock_table
+
+    # Patch the shared resource factory to return our mock resource
+    with patch('src.staging_lambda.lambda_pkg.services.dynamodb_service.aws_clients.resource') as mock_boto_resource, \
+         patch('src.staging_lambda.lambda_pkg.services.dynamodb_service.aws_clients.client', return_value=mock_client):
         mock_boto_resource.return_value = mock_resource
 
-        # Reload the service module *after* patching boto3.resource
+        # Reload the service module *after* patching aws_clients.resource
         # This ensures the module-level table variables use the mock resource
         import importlib
         importlib.reload(dynamodb_service)
@@ -55,7 +62,8 @@ def mock_dynamodb_resource():
         yield {
             "conversations": mock_conversations_table,
             "stage": mock_stage_table,
-            "lock": mock_lock_table
+            "lock": mock_lock_table,
+            "client": mock_client
         }
         # Optional: Reload again after tests to potentially restore original state
         importlib.reload(dynamodb_service) # Reload to reset module state potentially
@@ -69,46 +77,51 @@ def mock_dynamodb_resource():
 ])
 def test_get_credential_ref_success(mock_dynamodb_resource, channel_type, from_id, to_id, gsi_pk, gsi_sk, credential_key, expected_cred_ref):
     """Test successful GSI query and credential extraction."""
-    mock_conversations_table = mock_dynamodb_resource['conversations']
+    mock_client = mock_dynamodb_resource['client']
     mock_response = {
         'Items': [{
-            'conversation_id': 'conv_abc',
-            'channel_config': {credential_key: expected_cred_ref}
+            'conversation_id': {'S': 'conv_abc'},
+            'company_id': {'S': 'ci-aaa-000'},
+            'project_id': {'S': 'pi-aaa-000'},
+            'channel_config': {'M': {credential_key: {'S': expected_cred_ref}}}
         }]
     }
-    mock_conversations_table.query.return_value = mock_response
+    mock_client.query.return_value = mock_response
 
     result = dynamodb_service.get_credential_ref_for_validation(channel_type, from_id, to_id)
 
     assert result == {
         'status': 'FOUND',
         'credential_ref': expected_cred_ref,
-        'conversation_id': 'conv_abc'
+        'conversation_id': 'conv_abc',
+        'company_id': 'ci-aaa-000',
+        'project_id': 'pi-aaa-000'
     }
     # Verify the query arguments
     config = dynamodb_service.GSI_CONFIG[channel_type]
-    mock_conversations_table.query.assert_called_once_with(
+    mock_client.query.assert_called_once_with(
+        TableName=os.environ['CONVERSATIONS_TABLE_NAME'],
         IndexName=config['index_name'],
         KeyConditionExpression=f'{config["pk_name"]} = :pk AND {config["sk_name"]} = :sk',
-        ExpressionAttributeValues={':pk': gsi_pk, ':sk': gsi_sk},
-        ProjectionExpression='channel_config, conversation_id',
+        ExpressionAttributeValues={':pk': {'S': gsi_pk}, ':sk': {'S': gsi_sk}},
+        ProjectionExpression='channel_config, conversation_id, company_id, project_id',
         Limit=1
     )
 
 def test_get_credential_ref_not_found(mock_dynamodb_resource):
     """Test GSI query when no items are found."""
-    mock_conversations_table = mock_dynamodb_resource['conversations']
-    mock_conversations_table.query.return_value = {'Items': []}
+    mock_client = mock_dynamodb_resource['client']
+    mock_client.query.return_value = {'Items': []}
     result = dynamodb_service.get_credential_ref_for_validation('whatsapp', 'whatsapp:+111', 'whatsapp:+999')
     assert result == {'status': 'NOT_FOUND'}
 
 def test_get_credential_ref_missing_config_key(mock_dynamodb_resource):
     """Test GSI query when item found but credential key is missing in channel_config."""
-    mock_conversations_table = mock_dynamodb_resource['conversations']
-    mock_conversations_table.query.return_value = {
+    mock_client = mock_dynamodb_resource['client']
+    mock_client.query.return_value = {
         'Items': [{
-            'conversation_id': 'conv_abc',
-            'channel_config': {'other_key': 'value'} # Missing whatsapp_credentials_id
+            'conversation_id': {'S': 'conv_abc'},
+            'channel_config': {'M': {'other_key': {'S': 'value'}}} # Missing whatsapp_credentials_id
         }]
     }
     result = dynamodb_service.get_credential_ref_for_validation('whatsapp', 'whatsapp:+111', 'whatsapp:+999')
@@ -118,7 +131,7 @@ def test_get_credential_ref_unsupported_channel(mock_dynamodb_resource):
     """Test handling of unsupported channel type."""
     result = dynamodb_service.get_credential_ref_for_validation('telegram', 'id1', 'id2')
     assert result == {'status': 'UNSUPPORTED_CHANNEL'}
-    mock_dynamodb_resource['conversations'].query.assert_not_called()
+    mock_dynamodb_resource['client'].query.assert_not_called()
 
 @pytest.mark.parametrize(
     "aws_error_code, expected_status",
@@ -133,8 +146,8 @@ def test_get_credential_ref_unsupported_channel(mock_dynamodb_resource):
 )
 def test_get_credential_ref_client_error(mock_dynamodb_resource, aws_error_code, expected_status):
     """Test mapping of ClientErrors during GSI query."""
-    mock_conversations_table = mock_dynamodb_resource['conversations']
-    mock_conversations_table.query.side_effect = ClientError(
+    mock_client = mock_dynamodb_resource['client']
+    mock_client.query.side_effect = ClientError(
         error_response={'Error': {'Code': aws_error_code, 'Message': 'Test error'}},
         operation_name='Query'
     )
@@ -143,8 +156,8 @@ def test_get_credential_ref_client_error(mock_dynamodb_resource, aws_error_code,
 
 def test_get_credential_ref_unexpected_error(mock_dynamodb_resource):
     """Test handling of unexpected errors during GSI query."""
-    mock_conversations_table = mock_dynamodb_resource['conversations']
-    mock_conversations_table.query.side_effect = Exception("Something broke")
+    mock_client = mock_dynamodb_resource['client']
+    mock_client.query.side_effect = Exception("Something broke")
     result = dynamodb_service.get_credential_ref_for_validation('whatsapp', 'whatsapp:+111', 'whatsapp:+999')
     assert result == {'status': 'INTERNAL_ERROR'}
 
@@ -152,18 +165,40 @@ def test_get_credential_ref_unexpected_error(mock_dynamodb_resource):
 
 def test_get_full_conversation_success(mock_dynamodb_resource):
     """Test successful retrieval of a full conversation item."""
-    mock_conversations_table = mock_dynamodb_resource['conversations']
-    expected_item = {'primary_channel': 'user1', 'conversation_id': 'conv_abc', 'data': 'test'}
-    mock_conversations_table.get_item.return_value = {'Item': expected_item}
+    mock_client = mock_dynamodb_resource['client']
+    mock_client.get_item.return_value = {'Item': {
+        'primary_channel': {'S': 'user1'},
+        'conversation_id': {'S': 'conv_abc'},
+        'data': {'S': 'test'},
+        'task_complete': {'N': '0'}
+    }}
 
     result = dynamodb_service.get_full_conversation('user1', 'conv_abc')
-    assert result == {'status': 'FOUND', 'data': expected_item}
-    mock_conversations_table.get_item.assert_called_once_with(Key={'primary_channel': 'user1', 'conversation_id': 'conv_abc'})
+    assert result == {'status': 'FOUND', 'data': {
+        'primary_channel': 'user1', 'conversation_id': 'conv_abc', 'data': 'test', 'task_complete': Decimal(0)
+    }}
+    mock_client.get_item.assert_called_once_with(
+        TableName=os.environ['CONVERSATIONS_TABLE_NAME'],
+        Key={'primary_channel': {'S': 'user1'}, 'conversation_id': {'S': 'conv_abc'}}
+    )
+
+def test_get_full_conversation_projects_attributes(mock_dynamodb_resource):
+    """Only the requested attributes are read, via name placeholders (reserved words are safe)."""
+    mock_client = mock_dynamodb_resource['client']
+    mock_client.get_item.return_value = {'Item': {'conversation_id': {'S': 'conv_abc'}}}
+
+    dynamodb_service.get_full_conversation('user1', 'conv_abc', attributes=('conversation_id', 'messages'))
+    mock_client.get_item.assert_called_once_with(
+        TableName=os.environ['CONVERSATIONS_TABLE_NAME'],
+        Key={'primary_channel': {'S': 'user1'}, 'conversation_id': {'S': 'conv_abc'}},
+        ProjectionExpression='#a0, #a1',
+        ExpressionAttributeNames={'#a0': 'conversation_id', '#a1': 'messages'}
+    )
 
 def test_get_full_conversation_not_found(mock_dynamodb_resource):
     """Test get_item when the item is not found."""
-    mock_conversations_table = mock_dynamodb_resource['conversations']
-    mock_conversations_table.get_item.return_value = {} # No 'Item' key
+    mock_client = mock_dynamodb_resource['client']
+    mock_client.get_item.return_value = {} # No 'Item' key
     result = dynamodb_service.get_full_conversation('user1', 'conv_abc')
     assert result == {'status': 'NOT_FOUND'}
 
@@ -173,7 +208,7 @@ def test_get_full_conversation_empty_keys(mock_dynamodb_resource):
     result_sk = dynamodb_service.get_full_conversation('user1', '')
     assert result_pk == {'status': 'INTERNAL_ERROR'}
     assert result_sk == {'status': 'INTERNAL_ERROR'}
-    mock_dynamodb_resource['conversations'].get_item.assert_not_called()
+    mock_dynamodb_resource['client'].get_item.assert_not_called()
 
 @pytest.mark.parametrize(
     "aws_error_code, expected_status",
@@ -186,8 +221,8 @@ def test_get_full_conversation_empty_keys(mock_dynamodb_resource):
 )
 def test_get_full_conversation_client_error(mock_dynamodb_resource, aws_error_code, expected_status):
     """Test mapping of ClientErrors during get_item."""
-    mock_conversations_table = mock_dynamodb_resource['conversations']
-    mock_conversations_table.get_item.side_effect = ClientError(
+    mock_client = mock_dynamodb_resource['client']
+    mock_client.get_item.side_effect = ClientError(
         error_response={'Error': {'Code': aws_error_code, 'Message': 'Test error'}},
         operation_name='GetItem'
     )
@@ -196,8 +231,8 @@ def test_get_full_conversation_client_error(mock_dynamodb_resource, aws_error_co
 
 def test_get_full_conversation_unexpected_error(mock_dynamodb_resource):
     """Test handling of unexpected errors during get_item."""
-    mock_conversations_table = mock_dynamodb_resource['conversations']
-    mock_conversations_table.get_item.side_effect = Exception("Something broke")
+    mock_client = mock_dynamodb_resource['client']
+    mock_client.get_item.side_effect = Exception("Something broke")
     result = dynamodb_service.get_full_conversation('user1', 'conv_abc')
     assert result == {'status': 'INTERNAL_ERROR'}
 
@@ -206,7 +241,7 @@ def test_get_full_conversation_unexpected_error(mock_dynamodb_resource):
 @patch('src.staging_lambda.lambda_pkg.services.dynamodb_service.time.time')
 def test_write_to_stage_table_success(mock_time, mock_dynamodb_resource):
     """Test successful write to the stage table."""
-    mock_stage_table = mock_dynamodb_resource['stage']
+    mock_client = mock_dynamodb_resource['client']
     mock_time.return_value = 1700000000.0 # Fixed time for predictable TTL
     context = {
         'conversation_id': 'conv_xyz',
@@ -219,24 +254,33 @@ def test_write_to_stage_table_success(mock_time, mock_dynamodb_resource):
     result = dynamodb_service.write_to_stage_table(context)
     assert result == 'SUCCESS'
 
-    expected_ttl = 1700000000 + 10 + 60 # time() + BATCH_WINDOW + TTL_BUFFER
-    mock_stage_table.put_item.assert_called_once_with(Item={
-        'conversation_id': 'conv_xyz',
-        'message_sid': 'SM_sid_1',
-        'primary_channel': 'company_wa_num',
-        'body': 'Test message',
-        'received_at': ANY, # Use ANY for the timestamp
-        'expires_at': expected_ttl
+    expected_ttl = 1700000000 + 20 + 60 # time() + MAX_BATCH_WINDOW + TTL_BUFFER
+    mock_client.put_item.assert_called_once_with(TableName=os.environ['STAGE_TABLE_NAME'], Item={
+        'conversation_id': {'S': 'conv_xyz'},
+        'message_sid': {'S': 'SM_sid_1'},
+        'primary_channel': {'S': 'company_wa_num'},
+        'body': {'S': 'Test message'},
+        'received_at': {'S': ANY}, # Use ANY for the timestamp
+        'received_at_ms': {'N': '1700000000000'},
+        'expires_at': {'N': str(expected_ttl)}
     })
 
+@patch('src.staging_lambda.lambda_pkg.services.dynamodb_service.time.time', return_value=1700000000.0)
+def test_write_to_stage_table_extends_ttl(mock_time, mock_dynamodb_resource):
+    """Test the TTL covers a batch window lengthened under load."""
+    context = {'conversation_id': 'conv_xyz', 'message_sid': 'SM_sid_1'}
+    assert dynamodb_service.write_to_stage_table(context, window_extension_seconds=30) == 'SUCCESS'
+    item = mock_dynamodb_resource['client'].put_item.call_args.kwargs['Item']
+    assert item['expires_at'] == {'N': str(1700000000 + 20 + 30 + 60)}
+
 def test_write_to_stage_table_missing_keys(mock_dynamodb_resource):
     """Test failure when context is missing conversation_id or message_sid."""
-    mock_stage_table = mock_dynamodb_resource['stage']
+    mock_client = mock_dynamodb_resource['client']
     result1 = dynamodb_service.write_to_stage_table({'message_sid': 'sid1'})
     result2 = dynamodb_service.write_to_stage_table({'conversation_id': 'conv1'})
     assert result1 == 'INTERNAL_ERROR'
     assert result2 == 'INTERNAL_ERROR'
-    mock_stage_table.put_item.assert_not_called()
+    mock_client.put_item.assert_not_called()
 
 @pytest.mark.parametrize(
     "aws_error_code, expected_status",
@@ -249,8 +293,8 @@ def test_write_to_stage_table_missing_keys(mock_dynamodb_resource):
 )
 def test_write_to_stage_table_client_error(mock_dynamodb_resource, aws_error_code, expected_status):
     """Test mapping of ClientErrors during stage table write."""
-    mock_stage_table = mock_dynamodb_resource['stage']
-    mock_stage_table.put_item.side_effect = ClientError(
+    mock_client = mock_dynamodb_resource['client']
+    mock_client.put_item.side_effect = ClientError(
         error_response={'Error': {'Code': aws_error_code, 'Message': 'Test error'}},
         operation_name='PutItem'
     )
@@ -260,8 +304,8 @@ def test_write_to_stage_table_client_error(mock_dynamodb_resource, aws_error_cod
 
 def test_write_to_stage_table_unexpected_error(mock_dynamodb_resource):
     """Test handling of unexpected errors during stage table write."""
-    mock_stage_table = mock_dynamodb_resource['stage']
-    mock_stage_table.put_item.side_effect = Exception("Something broke")
+    mock_client = mock_dynamodb_resource['client']
+    mock_client.put_item.side_effect = Exception("Something broke")
     context = {'conversation_id': 'c1', 'message_sid': 's1'}
     result = dynamodb_service.write_to_stage_table(context)
     assert result == 'INTERNAL_ERROR'
@@ -271,35 +315,67 @@ def test_write_to_stage_table_unexpected_error(mock_dynamodb_resource):
 @patch('src.staging_lambda.lambda_pkg.services.dynamodb_service.time.time')
 def test_acquire_trigger_lock_success(mock_time, mock_dynamodb_resource):
     """Test successful acquisition of the trigger lock."""
-    mock_lock_table = mock_dynamodb_resource['lock']
+    mock_client = mock_dynamodb_resource['client']
     mock_time.return_value = 1700000100.0
+    mock_client.update_item.return_value = {}
     conv_id = 'conv_lock_1'
 
     result = dynamodb_service.acquire_trigger_lock(conv_id)
-    assert result == 'ACQUIRED'
-
-    expected_ttl = 1700000100 + 10 + 60
-    mock_lock_table.put_item.assert_called_once_with(
-        Item={'conversation_id': conv_id, 'expires_at': expected_ttl},
-        ConditionExpression='attribute_not_exists(conversation_id)'
+    assert result == {'status': 'ACQUIRED', 'batch_stats': {}}
+
+    mock_client.update_item.assert_called_once_with(
+        TableName=os.environ['LOCK_TABLE_NAME'],
+        Key={'conversation_id': {'S': conv_id}},
+        UpdateExpression='SET trigger_expires_at = :trigger_exp, expires_at = :exp',
+        ConditionExpression='attribute_not_exists(trigger_expires_at) OR trigger_expires_at < :now',
+        ExpressionAttributeValues={
+            ':trigger_exp': {'N': str(1700000100 + 20 + 60)}, # time() + MAX_BATCH_WINDOW + TTL_BUFFER
+            ':exp': {'N': str(1700000100 + dynamodb_service.BATCH_STATS_TTL_SECONDS)},
+            ':now': {'N': '1700000100'}
+        },
+        ReturnValues='ALL_OLD'
     )
 
+@patch('src.staging_lambda.lambda_pkg.services.dynamodb_service.time.time', return_value=1700000100.0)
+def test_acquire_trigger_lock_extends_safety_expiry(mock_time, mock_dynamodb_resource):
+    """Test the trigger safety expiry covers a batch window lengthened under load."""
+    mock_client = mock_dynamodb_resource['client']
+    mock_client.update_item.return_value = {}
+    dynamodb_service.acquire_trigger_lock('conv_lock_1', window_extension_seconds=30)
+    values = mock_client.update_item.call_args.kwargs['ExpressionAttributeValues']
+    assert values[':trigger_exp'] == {'N': str(1700000100 + 20 + 30 + 60)}
+
+def test_acquire_trigger_lock_returns_batch_stats(mock_dynamodb_resource):
+    """Test that stats stored on the previous lock item are returned on acquisition."""
+    mock_client = mock_dynamodb_resource['client']
+    mock_client.update_item.return_value = {'Attributes': {
+        'conversation_id': {'S': 'conv_stats'},
+        'expires_at': {'N': '1'},
+        'batch_count': {'N': '4'},
+        'gap_sum_ms': {'N': '9000'},
+        'gap_count': {'N': '3'}
+    }}
+
+    result = dynamodb_service.acquire_trigger_lock('conv_stats')
+    assert result['status'] == 'ACQUIRED'
+    assert result['batch_stats'] == {'batch_count': 4, 'gap_sum_ms': 9000, 'gap_count': 3}
+
 def test_acquire_trigger_lock_exists(mock_dynamodb_resource):
     """Test when the lock already exists (ConditionalCheckFailedException)."""
-    mock_lock_table = mock_dynamodb_resource['lock']
-    mock_lock_table.put_item.side_effect = ClientError(
+    mock_client = mock_dynamodb_resource['client']
+    mock_client.update_item.side_effect = ClientError(
         error_response={'Error': {'Code': 'ConditionalCheckFailedException', 'Message': 'Test fail'}},
-        operation_name='PutItem'
+        operation_name='UpdateItem'
     )
     result = dynamodb_service.acquire_trigger_lock('conv_exists')
-    assert result == 'EXISTS'
+    assert result == {'status': 'EXISTS'}
 
 def test_acquire_trigger_lock_missing_id(mock_dynamodb_resource):
     """Test failure when called with empty conversation_id."""
-    mock_lock_table = mock_dynamodb_resource['lock']
+    mock_client = mock_dynamodb_resource['client']
     result = dynamodb_service.acquire_trigger_lock('')
-    assert result == 'INTERNAL_ERROR'
-    mock_lock_table.put_item.assert_not_called()
+    assert result == {'status': 'INTERNAL_ERROR'}
+    mock_client.update_item.assert_not_called()
 
 @pytest.mark.parametrize(
     "aws_error_code, expected_status",
@@ -312,17 +388,131 @@ def test_acquire_trigger_lock_missing_id(mock_dynamodb_resource):
 )
 def test_acquire_trigger_lock_client_error(mock_dynamodb_resource, aws_error_code, expected_status):
     """Test mapping of ClientErrors (other than ConditionalCheck) during lock acquisition."""
-    mock_lock_table = mock_dynamodb_resource['lock']
-    mock_lock_table.put_item.side_effect = ClientError(
+    mock_client = mock_dynamodb_resource['client']
+    mock_client.update_item.side_effect = ClientError(
         error_response={'Error': {'Code': aws_error_code, 'Message': 'Test error'}},
-        operation_name='PutItem'
+        operation_name='UpdateItem'
     )
     result = dynamodb_service.acquire_trigger_lock('conv_err')
-    assert result == expected_status
+    assert result == {'status': expected_status}
 
 def test_acquire_trigger_lock_unexpected_error(mock_dynamodb_resource):
     """Test handling of unexpected errors during lock acquisition."""
-    mock_lock_table = mock_dynamodb_resource['lock']
-    mock_lock_table.put_item.side_effect = Exception("Something broke")
+    mock_client = mock_dynamodb_resource['client']
+    mock_client.update_item.side_effect = Exception("Something broke")
     result = dynamodb_service.acquire_trigger_lock('conv_unexp')
-    assert result == 'INTERNAL_ERROR' 
\ No newline at end of file
+    assert result == {'status': 'INTERNAL_ERROR'}
+
+# --- record_late_fragment Tests ---
+
+def test_record_late_fragment_success(mock_dynamodb_resource):
+    """Test that a late fragment increments split_count on the lock item."""
+    mock_lock_table = mock_dynamodb_resource['lock']
+    assert dynamodb_service.record_late_fragment('conv_late') is True
+    kwargs = mock_lock_table.update_item.call_args.kwargs
+    assert kwargs['Key'] == {'conversation_id': 'conv_late'}
+    assert 'ADD split_count :one' in kwargs['UpdateExpression']
+
+def test_record_late_fragment_error_is_swallowed(mock_dynamodb_resource):
+    """Test that failures are logged and reported as False, never raised."""
+    mock_lock_table = mock_dynamodb_resource['lock']
+    mock_lock_table.update_item.side_effect = Exception("Something broke")
+    assert dynamodb_service.record_late_fragment('conv_late') is False
+
+# --- set_comms_consent Tests ---
+
+def test_set_comms_consent_updates_conversation_item(mock_dynamodb_resource):
+    """An opt-out is a conditional update of comms_consent on the conversation item."""
+    mock_client = mock_dynamodb_resource['client']
+    mock_client.update_item.return_value = {}
+
+    assert dynamodb_service.set_comms_consent('+1', 'conv_abc', False, 'keyword:stop') == 'SUCCESS'
+
+    request = mock_client.update_item.call_args.kwargs
+    assert request['Key'] == {'primary_channel': {'S': '+1'}, 'conversation_id': {'S': 'conv_abc'}}
+    assert request['UpdateExpression'] == dynamodb_service.COMMS_CONSENT_UPDATE
+    assert request['ConditionExpression'] == 'attribute_exists(conversation_id)'
+    assert request['ExpressionAttributeValues'][':consent'] == {'BOOL': False}
+    assert request['ExpressionAttributeValues'][':source'] == {'S': 'keyword:stop'}
+
+@pytest.mark.parametrize("aws_error_code, expected_status", [
+    ('ConditionalCheckFailedException', 'NOT_FOUND'),
+    ('ProvisionedThroughputExceededException', 'DB_TRANSIENT_ERROR'),
+    ('ResourceNotFoundException', 'DB_CONFIG_ERROR'),
+    ('SomeOtherError', 'DB_UPDATE_ERROR'),
+])
+def test_set_comms_consent_client_error(mock_dynamodb_resource, aws_error_code, expected_status):
+    """Test mapping of ClientErrors during the consent update."""
+    mock_client = mock_dynamodb_resource['client']
+    mock_client.update_item.side_effect = ClientError({'Error': {'Code': aws_error_code, 'Message': 'x'}}, 'UpdateItem')
+    with patch.object(dynamodb_service.retry_policy, 'RETRY_ENABLED', False):
+        assert dynamodb_service.set_comms_consent('+1', 'conv_abc', True, 'keyword:start') == expected_status
+
+# --- reserve_rate_limit_tokens Tests ---
+
+def test_reserve_rate_limit_tokens_success(mock_dynamodb_resource):
+    """Test a reservation is a conditional atomic ADD on the time-bucketed counter item."""
+    mock_lock_table = mock_dynamodb_resource['lock']
+    mock_lock_table.update_item.return_value = {'Attributes': {'request_count': 13}}
+
+    result = dynamodb_service.reserve_rate_limit_tokens('ratelimit#ci-1#m#100', 3, 60, 6360)
+
+    assert result == {'status': 'RESERVED', 'count': 13}
+    mock_lock_table.update_item.assert_called_once_with(
+        Key={'conversation_id': 'ratelimit#ci-1#m#100'},
+        UpdateExpression='SET expires_at = if_not_exists(expires_at, :exp) ADD request_count :n',
+        ConditionExpression='attribute_not_exists(request_count) OR request_count <= :max_before',
+        ExpressionAttributeValues={':n': 3, ':max_before': 57, ':exp': 6360},
+        ReturnValues='UPDATED_NEW'
+    )
+
+def test_reserve_rate_limit_tokens_limit_exceeded(mock_dynamodb_resource):
+    """Test a failed condition means the counter has no room left."""
+    mock_lock_table = mock_dynamodb_resource['lock']
+    mock_lock_table.update_item.side_effect = ClientError(
+        error_response={'Error': {'Code': 'ConditionalCheckFailedException', 'Message': 'Test fail'}},
+        operation_name='UpdateItem'
+    )
+    result = dynamodb_service.reserve_rate_limit_tokens('ratelimit#ci-1#m#100', 1, 60, 6360)
+    assert result == {'status': 'LIMIT_EXCEEDED'}
+
+def test_release_rate_limit_tokens(mock_dynamodb_resource):
+    """Test released tokens are subtracted from the counter, never below zero."""
+    mock_lock_table = mock_dynamodb_resource['lock']
+    assert dynamodb_service.release_rate_limit_tokens('ratelimit#ci-1#m#100', 10) is True
+    kwargs = mock_lock_table.update_item.call_args.kwargs
+    assert kwargs['Key'] == {'conversation_id': 'ratelimit#ci-1#m#100'}
+    assert kwargs['UpdateExpression'] == 'ADD request_count :n'
+    assert kwargs['ConditionExpression'] == 'request_count >= :amount'
+    assert kwargs['ExpressionAttributeValues'] == {':n': -10, ':amount': 10}
+
+    mock_lock_table.update_item.side_effect = ClientError(
+        error_response={'Error': {'Code': 'ConditionalCheckFailedException', 'Message': 'Test fail'}},
+        operation_name='UpdateItem'
+    )
+    assert dynamodb_service.release_rate_limit_tokens('ratelimit#ci-1#m#100', 10) is False
+
+def test_reserve_rate_limit_tokens_invalid_amount(mock_dynamodb_resource):
+    """Test a lease larger than the limit is rejected without a DB call."""
+    mock_lock_table = mock_dynamodb_resource['lock']
+    assert dynamodb_service.reserve_rate_limit_tokens('ratelimit#ci-1#m#100', 5, 4, 6360) == {'status': 'INTERNAL_ERROR'}
+    mock_lock_table.update_item.assert_not_called()
+
+@pytest.mark.parametrize(
+    "aws_error_code, expected_status",
+    [
+        ('ThrottlingException', 'RATE_LIMIT_DB_TRANSIENT_ERROR'),
+        ('AccessDeniedException', 'RATE_LIMIT_DB_CONFIG_ERROR'),
+        ('ValidationException', 'RATE_LIMIT_DB_VALIDATION_ERROR'),
+        ('SomeOtherDynamoDBError', 'RATE_LIMIT_WRITE_ERROR'),
+    ]
+)
+def test_reserve_rate_limit_tokens_client_error(mock_dynamodb_resource, aws_error_code, expected_status):
+    """Test mapping of ClientErrors when updating a rate limit counter."""
+    mock_lock_table = mock_dynamodb_resource['lock']
+    mock_lock_table.update_item.side_effect = ClientError(
+        error_response={'Error': {'Code': aws_error_code, 'Message': 'Test error'}},
+        operation_name='UpdateItem'
+    )
+    result = dynamodb_service.reserve_rate_limit_tokens('ratelimit#ci-1#d#1', 1, 2000, 90000)
+    assert result == {'status': expected_status}
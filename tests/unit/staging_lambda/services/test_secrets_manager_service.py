@@ -19,8 +19,8 @@ def reset_secrets_manager_client():
 def mock_sm_client():
     """Provides a mock Secrets Manager client."""
     mock_client = MagicMock()
-    # Patch boto3.client to return our mock client
-    with patch('src.staging_lambda.lambda_pkg.services.secrets_manager_service.boto3.client') as mock_boto_client:
+    # Patch the shared client factory to return our mock client
+    with patch('src.staging_lambda.lambda_pkg.services.secrets_manager_service.aws_clients.client') as mock_boto_client:
         mock_boto_client.return_value = mock_client
         yield mock_client
 
@@ -112,7 +112,7 @@ def test_get_token_unexpected_exception(mock_sm_client):
 
 def test_client_initialization(reset_secrets_manager_client): # Use the reset fixture
     """Test that the client is initialized only once."""
-    with patch('src.staging_lambda.lambda_pkg.services.secrets_manager_service.boto3.client') as mock_boto_client:
+    with patch('src.staging_lambda.lambda_pkg.services.secrets_manager_service.aws_clients.client') as mock_boto_client:
         mock_boto_client.return_value = MagicMock()
 
         # Call the function multiple times
@@ -120,5 +120,5 @@ def test_client_initialization(reset_secrets_manager_client): # Use the reset fi
         secrets_manager_service.get_twilio_auth_token("id2")
         secrets_manager_service.get_twilio_auth_token("id3")
 
-        # Assert boto3.client was called only once
+        # Assert the client factory was called only once
         mock_boto_client.assert_called_once() 
\ No newline at end of file
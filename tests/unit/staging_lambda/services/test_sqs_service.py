@@ -1,10 +1,12 @@
 import pytest
 import json
 from unittest.mock import patch, MagicMock
+from decimal import Decimal
 from botocore.exceptions import ClientError
 
 # Use the correct absolute import path based on project structure
 from src.staging_lambda.lambda_pkg.services import sqs_service
+from src.staging_lambda.lambda_pkg.utils import payload_codec
 
 # Define constants used within the module for patching/verification
 MOCK_HANDOFF_URL = "mock_handoff_url_in_tests"
@@ -19,13 +21,13 @@ def mock_sqs_client():
     with patch('src.staging_lambda.lambda_pkg.services.sqs_service.HANDOFF_QUEUE_URL', MOCK_HANDOFF_URL), \
          patch('src.staging_lambda.lambda_pkg.services.sqs_service.BATCH_WINDOW_SECONDS', MOCK_BATCH_WINDOW):
         # Now patch the client that the functions will use
-        with patch('src.staging_lambda.lambda_pkg.services.sqs_service.boto3.client') as mock_boto_client:
+        with patch('src.staging_lambda.lambda_pkg.services.sqs_service.aws_clients.client') as mock_boto_client:
             mock_client = MagicMock()
             # Configure default success behaviour for send_message
             mock_client.send_message.return_value = {'MessageId': 'mock-message-id-from-fixture'}
             mock_boto_client.return_value = mock_client
 
-            # Reload the service module *after* patching boto3.client
+            # Reload the service module *after* patching aws_clients.client
             import importlib
             importlib.reload(sqs_service)
 
@@ -92,6 +94,58 @@ def test_send_to_channel_queue_email_success(mock_sqs_client, base_context):
         DelaySeconds=10 # Use actual default from source code
     )
 
+def test_send_to_fifo_channel_queue(mock_sqs_client, base_context):
+    """Test a FIFO trigger is grouped by conversation and deduplicated per batch window, without DelaySeconds."""
+    target_url = "mock_channel_queue_url.fifo"
+
+    with patch.object(sqs_service.time, 'time', return_value=1000.5):
+        result = sqs_service.send_message_to_queue(target_url, base_context, delay_seconds=10)
+
+    assert result == 'SUCCESS'
+    mock_sqs_client.send_message.assert_called_once_with(
+        QueueUrl=target_url,
+        MessageBody=json.dumps({
+            "conversation_id": "conv_sqs_123",
+            "primary_channel": "+1112223333",
+            "batch_deadline_ms": 1010000
+        }),
+        MessageGroupId="conv_sqs_123",
+        MessageDeduplicationId="conv_sqs_123:100"
+    )
+
+def test_fifo_fragments_with_different_extensions_share_one_dedup_id(mock_sqs_client, base_context):
+    """Test an admission extension moves the deadline but not the deduplication window."""
+    with patch.object(sqs_service.time, 'time', return_value=1000.5):
+        sqs_service.send_message_to_queue("mock_channel_queue_url.fifo", base_context, delay_seconds=10)
+        sqs_service.send_message_to_queue("mock_channel_queue_url.fifo", base_context, delay_seconds=10,
+                                          window_extension_seconds=15)
+
+    calls = [c.kwargs for c in mock_sqs_client.send_message.call_args_list]
+    assert {c['MessageDeduplicationId'] for c in calls} == {"conv_sqs_123:100"}
+    assert [json.loads(c['MessageBody'])['batch_deadline_ms'] for c in calls] == [1010000, 1025000]
+
+@pytest.mark.parametrize("now_ms, expected", [(0, (0, 10000)), (9999, (0, 10000)), (10000, (1, 20000)), (25000, (2, 30000))])
+def test_fifo_trigger_window(now_ms, expected):
+    """Test windows are aligned, so fragments sent in one window share a deduplication ID."""
+    assert sqs_service.fifo_trigger_window(10, now_ms=now_ms) == expected
+
+def test_fifo_ids_stay_within_sqs_limit(mock_sqs_client, base_context):
+    """Test an overlong conversation ID is hashed for the group and deduplication IDs."""
+    context = dict(base_context, conversation_id='c' * 200)
+    assert sqs_service.send_message_to_queue("mock_channel_queue_url.fifo", context) == 'SUCCESS'
+    kwargs = mock_sqs_client.send_message.call_args.kwargs
+    assert len(kwargs['MessageGroupId']) <= sqs_service.FIFO_MAX_ID_LENGTH
+    assert len(kwargs['MessageDeduplicationId']) <= sqs_service.FIFO_MAX_ID_LENGTH
+    assert 'DelaySeconds' not in kwargs
+
+@pytest.mark.parametrize("requested_delay, expected_delay", [(3, 3), (0, 0), (1200, 900), (-5, 0)])
+def test_send_to_channel_queue_explicit_delay(mock_sqs_client, base_context, requested_delay, expected_delay):
+    """Test an adaptive delay is used as-is, clamped to the SQS DelaySeconds range."""
+    result = sqs_service.send_message_to_queue("mock_channel_queue_url", base_context, delay_seconds=requested_delay)
+
+    assert result == 'SUCCESS'
+    assert mock_sqs_client.send_message.call_args.kwargs['DelaySeconds'] == expected_delay
+
 # def test_send_to_handoff_queue_success(mock_sqs_client, base_context):
 #     """Test sending the full context to the handoff queue."""
 #     target_url = MOCK_HANDOFF_URL # Target the mocked handoff URL
@@ -108,6 +162,38 @@ def test_send_to_channel_queue_email_success(mock_sqs_client, base_context):
 #         DelaySeconds=0 # No delay for handoff
 #     )
 
+def test_send_to_handoff_queue_encodes_context(mock_sqs_client, base_context):
+    """Test the handoff queue gets the full context through the payload codec (Decimals included)."""
+    context = dict(base_context, task_complete=Decimal(1))
+
+    result = sqs_service.send_message_to_queue(sqs_service.HANDOFF_QUEUE_URL, context)
+
+    assert result == 'SUCCESS'
+    kwargs = mock_sqs_client.send_message.call_args.kwargs
+    assert kwargs['QueueUrl'] == sqs_service.HANDOFF_QUEUE_URL
+    assert kwargs['DelaySeconds'] == 0
+    assert payload_codec.decode(kwargs['MessageBody']) == dict(base_context, task_complete=1)
+
+def test_send_to_handoff_unserializable(mock_sqs_client, base_context):
+    """Test a context the codec can't serialize is an internal error, not a send."""
+    context = dict(base_context, unserializable=object())
+    assert sqs_service.send_message_to_queue(sqs_service.HANDOFF_QUEUE_URL, context) == 'INTERNAL_ERROR'
+    mock_sqs_client.send_message.assert_not_called()
+
+@pytest.mark.parametrize(
+    "store_error, expected_status",
+    [
+        (ClientError({'Error': {'Code': 'SlowDown', 'Message': 'Test'}}, 'PutObject'), 'PAYLOAD_STORE_TRANSIENT_ERROR'),
+        (ClientError({'Error': {'Code': 'AccessDenied', 'Message': 'Test'}}, 'PutObject'), 'PAYLOAD_STORE_ERROR'),
+        (OSError("No space left on device"), 'PAYLOAD_STORE_ERROR'),
+    ]
+)
+def test_send_to_handoff_payload_store_error(mock_sqs_client, base_context, store_error, expected_status):
+    """Test claim-check store failures map to their own statuses."""
+    with patch.object(sqs_service.payload_codec, 'encode', side_effect=store_error):
+        assert sqs_service.send_message_to_queue(sqs_service.HANDOFF_QUEUE_URL, base_context) == expected_status
+    mock_sqs_client.send_message.assert_not_called()
+
 def test_send_invalid_input(mock_sqs_client):
     """Test handling of invalid input arguments."""
     result1 = sqs_service.send_message_to_queue(None, {'conversation_id': 'c1'})
@@ -150,6 +236,7 @@ def test_send_to_channel_missing_primary_channel(mock_sqs_client, base_context):
     [
         ('ServiceUnavailable', 'SQS_TRANSIENT_ERROR'),
         ('InternalFailure', 'SQS_TRANSIENT_ERROR'),
+        ('RequestThrottled', 'SQS_TRANSIENT_ERROR'),
         ('QueueDoesNotExist', 'SQS_CONFIG_ERROR'),
         ('AccessDenied', 'SQS_CONFIG_ERROR'),
         ('InvalidParameterValue', 'SQS_PARAMETER_ERROR'),
@@ -183,4 +270,20 @@ def test_send_unexpected_error(mock_sqs_client, base_context):
     mock_sqs_client.send_message.side_effect = Exception("Something broke")
 
     result = sqs_service.send_message_to_queue(target_url, context)
-    assert result == 'INTERNAL_ERROR' 
\ No newline at end of file
+    assert result == 'INTERNAL_ERROR' 
+
+def test_get_queue_depth(mock_sqs_client):
+    """Test the visible message count is read from the queue attributes."""
+    mock_sqs_client.get_queue_attributes.return_value = {'Attributes': {'ApproximateNumberOfMessages': '42'}}
+    assert sqs_service.get_queue_depth("mock_channel_queue_url") == 42
+    mock_sqs_client.get_queue_attributes.assert_called_once_with(
+        QueueUrl="mock_channel_queue_url", AttributeNames=['ApproximateNumberOfMessages']
+    )
+
+def test_get_queue_depth_error_returns_none(mock_sqs_client):
+    """Test a failed attribute read is reported as unknown depth."""
+    mock_sqs_client.get_queue_attributes.side_effect = ClientError(
+        error_response={'Error': {'Code': 'AccessDenied', 'Message': 'Test error'}},
+        operation_name='GetQueueAttributes'
+    )
+    assert sqs_service.get_queue_depth("mock_channel_queue_url") is None
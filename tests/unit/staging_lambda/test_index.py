@@ -7,6 +7,20 @@ from src.staging_lambda.lambda_pkg import index
 
 # --- Fixtures ---
 
+@pytest.fixture(autouse=True)
+def clean_sender_filter():
+    """NOT_FOUND lookups are remembered per container - don't let them leak between tests."""
+    index.sender_filter.reset_local_state()
+    yield
+    index.sender_filter.reset_local_state()
+
+@pytest.fixture(autouse=True)
+def clean_admission_controller():
+    """Throttled outcomes recorded by one test must not push the next one into shedding."""
+    index.admission_controller.reset_local_state()
+    yield
+    index.admission_controller.reset_local_state()
+
 @pytest.fixture
 def mock_event():
     """Provides a basic mock API Gateway event."""
@@ -55,6 +69,7 @@ def mock_dependencies(mock_parsing_success):
          patch('src.staging_lambda.lambda_pkg.index.routing.determine_target_queue') as mock_determine_queue, \
          patch('src.staging_lambda.lambda_pkg.index.dynamodb_service.write_to_stage_table') as mock_write_stage, \
          patch('src.staging_lambda.lambda_pkg.index.dynamodb_service.acquire_trigger_lock') as mock_acquire_lock, \
+         patch('src.staging_lambda.lambda_pkg.index.dynamodb_service.record_late_fragment') as mock_record_late, \
          patch('src.staging_lambda.lambda_pkg.index.sqs_service.send_message_to_queue') as mock_send_sqs, \
          patch('src.staging_lambda.lambda_pkg.index.response_builder') as mock_response_builder:
 
@@ -68,7 +83,8 @@ def mock_dependencies(mock_parsing_success):
         mock_validate_rules.return_value = {'valid': True}
         mock_determine_queue.return_value = 'mock_whatsapp_queue_url'
         mock_write_stage.return_value = 'SUCCESS'
-        mock_acquire_lock.return_value = 'ACQUIRED' # Default: lock acquired
+        mock_acquire_lock.return_value = {'status': 'ACQUIRED', 'batch_stats': {}} # Default: lock acquired
+        mock_record_late.return_value = True
         mock_send_sqs.return_value = 'SUCCESS'
         mock_response_builder.create_success_response_twiml.return_value = {'statusCode': 200, 'body': '<Response/>'}
         mock_response_builder.create_success_response_json.return_value = {'statusCode': 200, 'body': '{}'}
@@ -85,6 +101,7 @@ def mock_dependencies(mock_parsing_success):
             'determine_queue': mock_determine_queue,
             'write_stage': mock_write_stage,
             'acquire_lock': mock_acquire_lock,
+            'record_late': mock_record_late,
             'send_sqs': mock_send_sqs,
             'response_builder': mock_response_builder
         }
@@ -104,16 +121,48 @@ def test_handler_happy_path_lock_acquired(mock_event, mock_context, mock_depende
     mock_dependencies['validate_rules'].assert_called_once()
     mock_dependencies['determine_queue'].assert_called_once()
     mock_dependencies['write_stage'].assert_called_once()
-    mock_dependencies['acquire_lock'].assert_called_once_with('conv_1_2')
-    mock_dependencies['send_sqs'].assert_called_once_with('mock_whatsapp_queue_url', ANY)
+    mock_dependencies['acquire_lock'].assert_called_once_with('conv_1_2', window_extension_seconds=0)
+    mock_dependencies['send_sqs'].assert_called_once_with('mock_whatsapp_queue_url', ANY, delay_seconds=ANY, window_extension_seconds=0)
     mock_dependencies['response_builder'].create_success_response_twiml.assert_called_once()
 
     assert response['statusCode'] == 200
     assert response['body'] == '<Response/>'
 
+def test_handler_uses_cached_company_config(mock_event, mock_context, mock_dependencies):
+    """With a company-data record, only per-conversation fields are read and the config is overlaid."""
+    mock_dependencies['get_cred_ref'].return_value.update({'company_id': 'ci-1', 'project_id': 'pi-1'})
+    mock_dependencies['get_full_conv'].return_value = {'status': 'FOUND', 'data': {'conversation_status': 'reply_sent', 'project_status': 'stale'}}
+    company_record = {
+        'project_status': 'active',
+        'allowed_channels': ['whatsapp'],
+        'channel_config': {'whatsapp': {'whatsapp_credentials_id': 'secret_arn'}},
+    }
+    with patch('src.staging_lambda.lambda_pkg.index.company_config_service.get_company_config',
+               return_value=('FOUND', company_record)) as mock_config:
+        index.handler(mock_event, mock_context)
+
+    mock_config.assert_called_once_with('ci-1', 'pi-1')
+    mock_dependencies['get_full_conv'].assert_called_once_with(
+        '+1', 'conv_1_2', attributes=index.dynamodb_service.CONVERSATION_FIELDS
+    )
+    context_object = mock_dependencies['validate_rules'].call_args.args[0]
+    assert context_object['project_status'] == 'active'
+    assert context_object['conversation_status'] == 'reply_sent'
+    assert context_object['channel_config'] == {'whatsapp_credentials_id': 'secret_arn'}
+
+def test_handler_repeat_unknown_sender_skips_lookup(mock_event, mock_context, mock_dependencies):
+    """A NOT_FOUND lookup is remembered, so the same sender is rejected without another GSI query."""
+    mock_dependencies['get_cred_ref'].return_value = {'status': 'NOT_FOUND'}
+    index.handler(mock_event, mock_context)
+    index.handler(mock_event, mock_context)
+
+    mock_dependencies['get_cred_ref'].assert_called_once()
+    mock_dependencies['get_token'].assert_not_called()
+    assert mock_dependencies['response_builder'].create_success_response_twiml.call_count == 2
+
 def test_handler_happy_path_lock_exists(mock_event, mock_context, mock_dependencies):
     """Test the successful flow where lock already exists, SQS send is skipped."""
-    mock_dependencies['acquire_lock'].return_value = 'EXISTS' # Simulate lock existing
+    mock_dependencies['acquire_lock'].return_value = {'status': 'EXISTS'} # Simulate lock existing
 
     response = index.handler(mock_event, mock_context)
 
@@ -133,10 +182,159 @@ def test_handler_handoff_routing(mock_event, mock_context, mock_dependencies):
 
         # Assert lock acquisition was SKIPPED, SQS send was called with handoff URL
         mock_dependencies['acquire_lock'].assert_not_called()
-        mock_dependencies['send_sqs'].assert_called_once_with(mock_handoff_url, ANY)
+        mock_dependencies['send_sqs'].assert_called_once_with(mock_handoff_url, ANY, delay_seconds=None, window_extension_seconds=0)
         mock_dependencies['response_builder'].create_success_response_twiml.assert_called_once()
         assert response['statusCode'] == 200
 
+def _with_keyword_rules(mock_dependencies, body, rules):
+    mock_dependencies['parse'].return_value['context_object']['body'] = body
+    mock_dependencies['get_full_conv'].return_value = {'status': 'FOUND', 'data': {
+        'project_status': 'active', 'allowed_channels': ['whatsapp'], 'keyword_rules': rules}}
+
+def test_handler_keyword_opt_out_skips_staging_and_ai(mock_event, mock_context, mock_dependencies):
+    """A STOP message records the opt-out and gets the canned reply; nothing is staged or queued."""
+    _with_keyword_rules(mock_dependencies, 'Stop', [{'keywords': ['stop'], 'action': 'opt_out', 'reply': 'Bye & thanks'}])
+    with patch('src.staging_lambda.lambda_pkg.index.dynamodb_service.set_comms_consent', return_value='SUCCESS') as mock_consent:
+        index.handler(mock_event, mock_context)
+
+    mock_consent.assert_called_once_with('+1', 'conv_1_2', False, 'keyword:0')
+    mock_dependencies['response_builder'].create_twiml_error_response.assert_called_once_with('Bye &amp; thanks')
+    mock_dependencies['determine_queue'].assert_not_called()
+    mock_dependencies['write_stage'].assert_not_called()
+    mock_dependencies['send_sqs'].assert_not_called()
+
+def test_handler_keyword_opt_out_retried_on_transient_error(mock_event, mock_context, mock_dependencies):
+    """An opt-out must not be lost: a throttled consent update makes Twilio redeliver."""
+    _with_keyword_rules(mock_dependencies, 'STOP', [{'keywords': ['stop'], 'action': 'opt_out'}])
+    with patch('src.staging_lambda.lambda_pkg.index.dynamodb_service.set_comms_consent', return_value='DB_TRANSIENT_ERROR'):
+        with pytest.raises(Exception, match='DB_TRANSIENT_ERROR'):
+            index.handler(mock_event, mock_context)
+    mock_dependencies['write_stage'].assert_not_called()
+
+def test_handler_rate_limit_applies_before_keyword_replies(mock_event, mock_context, mock_dependencies):
+    """Over the rate limit, a keyword rule sends no canned reply."""
+    _with_keyword_rules(mock_dependencies, 'hours', [{'keywords': ['hours'], 'action': 'reply', 'reply': 'Open 9-5'}])
+    with patch('src.staging_lambda.lambda_pkg.index.rate_limiter.check_rate_limit',
+               return_value={'valid': False, 'error_code': 'RATE_LIMITED', 'message': 'Too many'}):
+        index.handler(mock_event, mock_context)
+
+    mock_dependencies['response_builder'].create_twiml_error_response.assert_called_once_with(index.RATE_LIMITED_TWIML_MESSAGE)
+    mock_dependencies['write_stage'].assert_not_called()
+
+def test_handler_rate_limited_opt_out_is_still_recorded(mock_event, mock_context, mock_dependencies):
+    """Over the rate limit, an opt-out is recorded but its canned reply is withheld."""
+    _with_keyword_rules(mock_dependencies, 'Stop', [{'keywords': ['stop'], 'action': 'opt_out', 'reply': 'Bye'}])
+    with patch('src.staging_lambda.lambda_pkg.index.rate_limiter.check_rate_limit',
+               return_value={'valid': False, 'error_code': 'RATE_LIMITED', 'message': 'Too many'}), \
+         patch('src.staging_lambda.lambda_pkg.index.dynamodb_service.set_comms_consent', return_value='SUCCESS') as mock_consent:
+        index.handler(mock_event, mock_context)
+
+    mock_consent.assert_called_once_with('+1', 'conv_1_2', False, 'keyword:0')
+    mock_dependencies['response_builder'].create_twiml_error_response.assert_called_once_with(index.RATE_LIMITED_TWIML_MESSAGE)
+
+def test_handler_keyword_handoff_routes_to_handoff_queue(mock_event, mock_context, mock_dependencies):
+    """A handoff rule stages the message for the handoff queue instead of the AI."""
+    _with_keyword_rules(mock_dependencies, 'agent please', [{'name': 'agent', 'pattern': 'agent', 'action': 'handoff'}])
+    with patch('src.staging_lambda.lambda_pkg.index.routing.HANDOFF_QUEUE_URL', 'mock_handoff_url'):
+        index.handler(mock_event, mock_context)
+
+    mock_dependencies['determine_queue'].assert_not_called()
+    mock_dependencies['acquire_lock'].assert_not_called()
+    mock_dependencies['send_sqs'].assert_called_once_with('mock_handoff_url', ANY, delay_seconds=None, window_extension_seconds=0)
+    assert mock_dependencies['send_sqs'].call_args.args[1]['keyword_rule'] == 'agent'
+    mock_dependencies['response_builder'].create_success_response_twiml.assert_called_once()
+
+def test_handler_adaptive_delay_passed_to_trigger(mock_event, mock_context, mock_dependencies):
+    """Test the trigger delay is chosen from the stats returned with the lock."""
+    stats = {'batch_count': 5, 'fragment_count': 5}
+    mock_dependencies['acquire_lock'].return_value = {'status': 'ACQUIRED', 'batch_stats': stats}
+
+    with patch('src.staging_lambda.lambda_pkg.index.batch_window.choose_delay_seconds', return_value=4) as mock_choose:
+        index.handler(mock_event, mock_context)
+
+    mock_choose.assert_called_once_with(ANY, stats)
+    mock_dependencies['send_sqs'].assert_called_once_with('mock_whatsapp_queue_url', ANY, delay_seconds=4, window_extension_seconds=0)
+
+def test_handler_fifo_queue_skips_trigger_lock(mock_event, mock_context, mock_dependencies):
+    """Test a FIFO channel queue gets its trigger without the trigger-lock round trip."""
+    mock_dependencies['determine_queue'].return_value = 'mock_whatsapp_queue_url.fifo'
+
+    response = index.handler(mock_event, mock_context)
+
+    mock_dependencies['acquire_lock'].assert_not_called()
+    mock_dependencies['send_sqs'].assert_called_once_with(
+        'mock_whatsapp_queue_url.fifo', ANY, delay_seconds=index.batch_window.BATCH_WINDOW_SECONDS,
+        window_extension_seconds=0
+    )
+    assert response['statusCode'] == 200
+
+def test_handler_fifo_extension_moves_deadline_not_window(mock_event, mock_context, mock_dependencies):
+    """Test an admission extension on a FIFO queue is passed on separately from the dedup window."""
+    mock_dependencies['determine_queue'].return_value = 'mock_whatsapp_queue_url.fifo'
+    degraded = {'admitted': True, 'state': 'degraded', 'pressure': 0.75, 'window_extension_seconds': 15}
+    with patch('src.staging_lambda.lambda_pkg.index.admission_controller.admit', return_value=degraded):
+        index.handler(mock_event, mock_context)
+
+    mock_dependencies['send_sqs'].assert_called_once_with(
+        'mock_whatsapp_queue_url.fifo', ANY, delay_seconds=index.batch_window.BATCH_WINDOW_SECONDS,
+        window_extension_seconds=15
+    )
+
+def test_handler_conversation_locked_records_late_fragment(mock_event, mock_context, mock_dependencies):
+    """Test a fragment rejected by the processing lock is counted as a batch split."""
+    mock_dependencies['validate_rules'].return_value = {
+        'valid': False, 'error_code': 'CONVERSATION_LOCKED', 'error_message': 'Locked'
+    }
+
+    index.handler(mock_event, mock_context)
+
+    mock_dependencies['record_late'].assert_called_once_with('conv_1_2')
+    mock_dependencies['write_stage'].assert_not_called()
+
+def test_handler_rate_limited_skips_staging(mock_event, mock_context, mock_dependencies):
+    """Test a request over the company's rate limit is answered without staging or queuing."""
+    with patch('src.staging_lambda.lambda_pkg.index.rate_limiter.check_rate_limit',
+               return_value={'valid': False, 'error_code': 'RATE_LIMITED', 'message': 'Too many'}) as mock_check:
+        response = index.handler(mock_event, mock_context)
+
+    mock_check.assert_called_once()
+    mock_dependencies['write_stage'].assert_not_called()
+    mock_dependencies['send_sqs'].assert_not_called()
+    mock_dependencies['response_builder'].create_twiml_error_response.assert_called_once_with(index.RATE_LIMITED_TWIML_MESSAGE)
+    assert response['statusCode'] == 200
+
+def test_handler_sheds_load_when_overloaded(mock_event, mock_context, mock_dependencies):
+    """Test a shed request takes the transient path before any downstream call."""
+    shed = {'admitted': False, 'error_code': 'OVERLOADED', 'message': 'Overloaded', 'state': 'shedding', 'pressure': 3.0}
+    with patch('src.staging_lambda.lambda_pkg.index.admission_controller.admit', return_value=shed):
+        with pytest.raises(Exception) as excinfo:
+            index.handler(mock_event, mock_context)
+
+    assert "Transient server error: OVERLOADED" in str(excinfo.value)
+    mock_dependencies['get_cred_ref'].assert_not_called()
+    mock_dependencies['write_stage'].assert_not_called()
+
+def test_handler_degraded_lengthens_window_and_ttls(mock_event, mock_context, mock_dependencies):
+    """Test a degraded controller extends the trigger delay and the stage/lock TTLs."""
+    degraded = {'admitted': True, 'state': 'degraded', 'pressure': 0.75, 'window_extension_seconds': 15}
+    with patch('src.staging_lambda.lambda_pkg.index.admission_controller.admit', return_value=degraded), \
+         patch('src.staging_lambda.lambda_pkg.index.batch_window.choose_delay_seconds', return_value=3):
+        index.handler(mock_event, mock_context)
+
+    mock_dependencies['write_stage'].assert_called_once_with(ANY, window_extension_seconds=15)
+    mock_dependencies['acquire_lock'].assert_called_once_with('conv_1_2', window_extension_seconds=15)
+    mock_dependencies['send_sqs'].assert_called_once_with('mock_whatsapp_queue_url', ANY, delay_seconds=18, window_extension_seconds=0)
+
+def test_handler_records_downstream_outcomes(mock_event, mock_context, mock_dependencies):
+    """Test throttled service results feed the admission controller."""
+    mock_dependencies['write_stage'].return_value = 'STAGE_DB_TRANSIENT_ERROR'
+    with patch('src.staging_lambda.lambda_pkg.index.admission_controller.record') as mock_record:
+        with pytest.raises(Exception):
+            index.handler(mock_event, mock_context)
+
+    outcomes = [(c.args[0], c.args[1]) for c in mock_record.call_args_list]
+    assert outcomes == [('dynamodb', False), ('dynamodb', False), ('dynamodb', True)]
+
 def test_handler_parsing_failure(mock_event, mock_context, mock_dependencies):
     """Test failure during the initial parsing step."""
     mock_dependencies['parse'].return_value = {'success': False}
@@ -190,7 +388,7 @@ def test_handler_invalid_signature(mock_event, mock_context, mock_dependencies):
 
 # Test transient error handling
 @pytest.mark.parametrize("transient_error_code", list(index.TRANSIENT_ERROR_CODES))
-def test_handler_transient_error_raises(mock_event, mock_context, mock_dependencies, transient_error_code):
+def test_handler_transient_error_raises(mock_event, mock_context, mock_dependencies, transient_error_code, monkeypatch):
     """Test that transient errors from services correctly raise an exception."""
 
     # Configure the relevant mock to return a transient error status
@@ -208,9 +406,13 @@ def test_handler_transient_error_raises(mock_event, mock_context, mock_dependenc
     elif transient_error_code == 'STAGE_DB_TRANSIENT_ERROR':
         mock_dependencies['write_stage'].return_value = transient_error_code
     elif transient_error_code == 'TRIGGER_DB_TRANSIENT_ERROR':
-        mock_dependencies['acquire_lock'].return_value = transient_error_code
-    elif transient_error_code == 'SQS_TRANSIENT_ERROR':
+        mock_dependencies['acquire_lock'].return_value = {'status': transient_error_code}
+    elif transient_error_code in ('SQS_TRANSIENT_ERROR', 'PAYLOAD_STORE_TRANSIENT_ERROR'):
         mock_dependencies['send_sqs'].return_value = transient_error_code
+    elif transient_error_code == 'OVERLOADED':
+        monkeypatch.setattr(index.admission_controller, 'admit', lambda channel_type: {
+            'admitted': False, 'error_code': transient_error_code, 'state': 'shedding', 'pressure': 2.0
+        })
     else:
         pytest.skip(f"Skipping untested transient code: {transient_error_code}")
 
@@ -365,4 +567,20 @@ def test_handler_logic(event_body, expected_status_code, expected_mock_calls, mo
             # ... add more specific assertions based on test cases ...
 
 # Add more test functions following the same pattern of importing inside
-# and mocking dependencies. 
\ No newline at end of file
+# and mocking dependencies. 
+@patch('src.staging_lambda.lambda_pkg.index.response_builder')
+def test_determine_error_rate_limited_uses_configured_twiml(mock_rb):
+    """Test RATE_LIMITED replies with the configured message, or empty TwiML when blank."""
+    index._determine_final_error_response('whatsapp', 'RATE_LIMITED', "Too many")
+    mock_rb.create_twiml_error_response.assert_called_once_with(index.RATE_LIMITED_TWIML_MESSAGE)
+
+    with patch.dict(index.LIMIT_TWIML_MESSAGES, {'RATE_LIMITED': ''}):
+        index._determine_final_error_response('whatsapp', 'RATE_LIMITED', "Too many")
+    mock_rb.create_success_response_twiml.assert_called_once()
+
+@patch('src.staging_lambda.lambda_pkg.index.response_builder')
+def test_determine_error_limit_twiml_is_escaped(mock_rb):
+    """Test operator-set limit messages are XML-escaped before going into TwiML."""
+    with patch.dict(index.LIMIT_TWIML_MESSAGES, {'MESSAGE_TOO_LONG': 'Max 1600 chars <please> & thanks'}):
+        index._determine_final_error_response('whatsapp', 'MESSAGE_TOO_LONG', "Too long")
+    mock_rb.create_twiml_error_response.assert_called_once_with('Max 1600 chars &lt;please&gt; &amp; thanks')
@@ -0,0 +1,61 @@
+import pytest
+from unittest.mock import patch
+
+from src.staging_lambda.lambda_pkg.utils import aws_clients
+
+# --- Fixtures ---
+
+@pytest.fixture(autouse=True)
+def fresh_factory():
+    """Own caches, so the tests neither see nor replace the clients the services already hold."""
+    with patch.object(aws_clients, '_session', None), \
+         patch.object(aws_clients, '_clients', {}), \
+         patch.object(aws_clients, '_resources', {}):
+        yield
+
+# --- Test Cases ---
+
+def test_one_client_per_service():
+    sqs = aws_clients.client('sqs')
+    assert aws_clients.client('sqs') is sqs
+    assert aws_clients.client('secretsmanager') is not sqs
+    assert aws_clients.resource('dynamodb') is aws_clients.resource('dynamodb')
+
+def test_dynamodb_client_is_not_the_resource_client():
+    """boto3 hooks its (de)serializers into the resource's client - wire-format calls need a plain one."""
+    client = aws_clients.client('dynamodb')
+    assert client is not aws_clients.resource('dynamodb').meta.client
+    assert client.meta.config.max_pool_connections == aws_clients.AWS_MAX_POOL_CONNECTIONS
+
+def test_clients_share_one_session():
+    with patch.object(aws_clients.boto3.session, 'Session', wraps=aws_clients.boto3.session.Session) as mock_session:
+        aws_clients.client('sqs')
+        aws_clients.client('secretsmanager')
+        aws_clients.resource('dynamodb')
+    mock_session.assert_called_once_with(region_name=aws_clients.AWS_REGION)
+
+def test_client_config():
+    config = aws_clients.client('sqs').meta.config
+    assert config.max_pool_connections == aws_clients.AWS_MAX_POOL_CONNECTIONS
+    assert config.tcp_keepalive is aws_clients.AWS_TCP_KEEPALIVE
+    assert config.retries['mode'] == aws_clients.AWS_RETRY_MODE
+    # retry_policy owns retries - botocore makes a single attempt
+    assert config.retries['total_max_attempts'] == aws_clients.AWS_RETRY_MAX_ATTEMPTS == 1
+    assert config.region_name == aws_clients.AWS_REGION
+
+def test_endpoint_overrides(monkeypatch):
+    monkeypatch.setenv('AWS_ENDPOINT_URL', 'http://localhost:4566')
+    monkeypatch.setenv('AWS_ENDPOINT_URL_DYNAMODB', 'http://localhost:8000')
+    assert aws_clients.endpoint_url('dynamodb') == 'http://localhost:8000'
+    assert aws_clients.endpoint_url('sqs') == 'http://localhost:4566'
+    assert aws_clients.client('sqs').meta.endpoint_url == 'http://localhost:4566'
+
+def test_no_endpoint_override_by_default(monkeypatch):
+    for variable in ['AWS_ENDPOINT_URL', *aws_clients.ENDPOINT_URL_VARIABLES.values()]:
+        monkeypatch.delenv(variable, raising=False)
+    assert aws_clients.endpoint_url('secretsmanager') is None
+
+def test_reset_local_state_rebuilds_clients():
+    sqs = aws_clients.client('sqs')
+    aws_clients.reset_local_state()
+    assert aws_clients.client('sqs') is not sqs
@@ -0,0 +1,98 @@
+import pytest
+from unittest.mock import patch, MagicMock
+
+from src.staging_lambda.lambda_pkg.utils import metrics
+from src.staging_lambda.lambda_pkg import index
+
+# --- Fixtures ---
+
+@pytest.fixture
+def memory_sink():
+    """Routes metric output to an in-memory sink for the duration of a test."""
+    sink = metrics.MemorySink()
+    previous = metrics.set_sink(sink)
+    metrics.flush() # Drop anything buffered by earlier tests
+    sink.clear()
+    yield sink
+    metrics.set_sink(previous)
+
+# --- Test Cases ---
+
+def test_timer_records_and_flush_emits_emf(memory_sink):
+    metrics.set_dimensions(channel='whatsapp', company_id='ci-aaa-000')
+    with metrics.timer('parse'):
+        pass
+    metrics.put_metric('parse', 2.5)
+    metrics.flush()
+
+    assert len(memory_sink.documents) == 1
+    document = memory_sink.documents[0]
+    emf = document['_aws']['CloudWatchMetrics'][0]
+    assert emf['Namespace'] == metrics.METRICS_NAMESPACE
+    assert emf['Dimensions'] == [['Service', 'Channel', 'CompanyId'], ['Service']]
+    assert emf['Metrics'] == [{'Name': 'parse', 'Unit': 'Milliseconds'}]
+    assert document['Channel'] == 'whatsapp'
+    assert document['CompanyId'] == 'ci-aaa-000'
+    assert len(document['parse']) == 2 and document['parse'][1] == 2.5
+
+def test_flush_clears_buffer(memory_sink):
+    metrics.put_metric('sqs_send', 1.0)
+    metrics.flush()
+    metrics.flush()
+    assert len(memory_sink.documents) == 1
+
+def test_scopes_group_by_dimensions(memory_sink):
+    metrics.begin_scope(channel='whatsapp', company_id='c1')
+    metrics.put_metric('stage_write', 1.0)
+    metrics.begin_scope(channel='whatsapp', company_id='c2')
+    metrics.put_metric('stage_write', 2.0)
+    metrics.begin_scope(channel='whatsapp', company_id='c1')
+    metrics.put_metric('stage_write', 3.0)
+    metrics.flush()
+
+    assert len(memory_sink.documents) == 2
+    assert sorted(memory_sink.values('stage_write', company_id='c1')) == [1.0, 3.0]
+    assert memory_sink.values('stage_write', company_id='c2') == [2.0]
+
+def test_more_than_100_values_split_across_documents(memory_sink):
+    for i in range(150):
+        metrics.put_metric('gsi_lookup', float(i))
+    metrics.flush()
+
+    assert len(memory_sink.documents) == 2
+    assert len(memory_sink.values('gsi_lookup')) == 150
+
+def test_missing_dimensions_default_to_unknown(memory_sink):
+    metrics.put_metric('parse', 1.0)
+    metrics.flush()
+    assert memory_sink.documents[0]['Channel'] == 'unknown'
+    assert memory_sink.documents[0]['CompanyId'] == 'unknown'
+
+def test_disabled_metrics_emit_nothing(memory_sink):
+    with patch.object(metrics, 'METRICS_ENABLED', False):
+        metrics.put_metric('parse', 1.0)
+        metrics.flush()
+    assert memory_sink.documents == []
+
+def test_sink_failure_does_not_raise(memory_sink):
+    failing_sink = MagicMock()
+    failing_sink.emit.side_effect = RuntimeError("sink down")
+    metrics.set_sink(failing_sink)
+    metrics.put_metric('parse', 1.0)
+    metrics.flush() # Must not raise
+
+def test_snapshot_aggregates_unflushed_values(memory_sink):
+    metrics.put_metric('trigger_lock', 4.0)
+    metrics.put_metric('trigger_lock', 2.0)
+    summary = metrics.snapshot()
+    assert summary['trigger_lock'] == {'count': 2, 'sum': 6.0, 'min': 2.0, 'max': 4.0}
+    metrics.flush()
+
+def test_handler_flushes_once_per_invocation(memory_sink):
+    """The handler emits its stage timings once, even on an early error return."""
+    with patch('src.staging_lambda.lambda_pkg.index.parsing_utils.parse_incoming_request', return_value={'success': False}), \
+         patch('src.staging_lambda.lambda_pkg.index.response_builder'):
+        index.handler({'path': '/whatsapp'}, MagicMock())
+
+    assert len(memory_sink.documents) == 1
+    assert len(memory_sink.values('parse')) == 1
@@ -0,0 +1,114 @@
+import pytest
+import json
+import io
+from decimal import Decimal
+from unittest.mock import patch, MagicMock
+from boto3.dynamodb.types import Binary
+
+from src.staging_lambda.lambda_pkg.utils import payload_codec
+
+# --- Helpers & Fixtures ---
+
+def conversation(message_count, content='message body that repeats a bit '):
+    """A context object shaped like the handoff one, with Decimal values from the resource layer."""
+    return {
+        'conversation_id': 'conv_codec',
+        'task_complete': Decimal(0),
+        'initial_processing_time_ms': Decimal('1234'),
+        'score': Decimal('0.75'),
+        'messages': [
+            {'role': 'user', 'content': f"{content}{i}", 'timestamp': '2024-01-01T12:00:00+00:00'}
+            for i in range(message_count)
+        ]
+    }
+
+@pytest.fixture(autouse=True)
+def file_store(tmp_path):
+    """Directory store under tmp_path, default thresholds."""
+    with patch.object(payload_codec, 'PAYLOAD_BUCKET', None), \
+         patch.object(payload_codec, 'PAYLOAD_STORE_DIR', str(tmp_path)), \
+         patch.object(payload_codec, 'PAYLOAD_COMPRESS_THRESHOLD_BYTES', 16 * 1024), \
+         patch.object(payload_codec, 'PAYLOAD_MAX_INLINE_BYTES', 240 * 1024):
+        yield tmp_path
+
+# --- Test Cases ---
+
+def test_small_payload_is_plain_json_with_decimals_converted():
+    body = payload_codec.encode(conversation(2))
+    message = json.loads(body)
+    assert message['task_complete'] == 0 and isinstance(message['task_complete'], int)
+    assert message['initial_processing_time_ms'] == 1234
+    assert message['score'] == 0.75
+    assert payload_codec.decode(body) == message
+
+def test_sets_and_binary_are_serialized():
+    body = payload_codec.encode({'tags': {'b', 'a'}, 'blob': Binary(b'\x00\x01'), 'raw': b'hi'})
+    assert json.loads(body) == {'tags': ['a', 'b'], 'blob': 'AAE=', 'raw': 'aGk='}
+
+def test_unserializable_value_raises_type_error():
+    with pytest.raises(TypeError):
+        payload_codec.encode({'conversation_id': 'c1', 'bad': object()})
+
+def test_large_payload_is_compressed_inline(file_store):
+    payload = conversation(400) # ~40 KB of JSON
+    body = payload_codec.encode(payload)
+    message = json.loads(body)
+    assert message[payload_codec.ENCODING_KEY] == payload_codec.ENCODING_COMPRESSED
+    assert len(body) < len(payload_codec.to_json_bytes(payload))
+    assert payload_codec.decode(body) == json.loads(payload_codec.to_json_bytes(payload))
+    assert not any(file_store.iterdir())
+
+def test_oversized_payload_is_claim_checked(file_store):
+    payload = conversation(300)
+    with patch.object(payload_codec, 'PAYLOAD_MAX_INLINE_BYTES', 1024):
+        body = payload_codec.encode(payload)
+        message = json.loads(body)
+        assert message[payload_codec.ENCODING_KEY] == payload_codec.ENCODING_CLAIM_CHECK
+        assert message['location'].startswith(f"file://{file_store}")
+        assert message['bytes'] == len(payload_codec.to_json_bytes(payload))
+        assert len(body) < 1024
+
+        # Same payload, same object - a retried send doesn't add one
+        assert payload_codec.encode(payload) == body
+        assert payload_codec.decode(body) == json.loads(payload_codec.to_json_bytes(payload))
+
+def test_claim_check_checksum_mismatch_is_rejected(file_store):
+    with patch.object(payload_codec, 'PAYLOAD_MAX_INLINE_BYTES', 1024):
+        body = payload_codec.encode(conversation(300))
+    path = json.loads(body)['location'][len('file://'):]
+    with open(path, 'ab') as f:
+        f.write(b'tampered')
+    with pytest.raises(ValueError):
+        payload_codec.decode(body)
+
+def test_claim_check_uses_s3_when_bucket_configured():
+    stored = {}
+    s3 = MagicMock()
+    s3.put_object.side_effect = lambda Bucket, Key, Body: stored.update({(Bucket, Key): Body})
+    s3.get_object.side_effect = lambda Bucket, Key: {'Body': io.BytesIO(stored[(Bucket, Key)])}
+    payload = conversation(300)
+    with patch.object(payload_codec, 'PAYLOAD_BUCKET', 'payload-bucket'), \
+         patch.object(payload_codec, 'PAYLOAD_MAX_INLINE_BYTES', 1024), \
+         patch.object(payload_codec.aws_clients, 'client', return_value=s3) as mock_client:
+        body = payload_codec.encode(payload)
+        location = json.loads(body)['location']
+        assert location.startswith(f"s3://payload-bucket/{payload_codec.PAYLOAD_KEY_PREFIX}")
+        assert payload_codec.decode(body) == json.loads(payload_codec.to_json_bytes(payload))
+    mock_client.assert_called_with('s3')
+    s3.put_object.assert_called_once()
+
+def test_oversized_payload_without_store_is_sent_inline(caplog):
+    """No bucket and no store directory: no claim check to /tmp, an error and the payload inline."""
+    payload = conversation(300)
+    with patch.object(payload_codec, 'PAYLOAD_STORE_DIR', None), \
+         patch.object(payload_codec, 'PAYLOAD_MAX_INLINE_BYTES', 1024), \
+         patch.object(payload_codec, '_put_object') as mock_put:
+        body = payload_codec.encode(payload)
+    mock_put.assert_not_called()
+    assert json.loads(body)[payload_codec.ENCODING_KEY] == payload_codec.ENCODING_COMPRESSED
+    assert payload_codec.decode(body) == json.loads(payload_codec.to_json_bytes(payload))
+    assert "no payload store is configured" in caplog.text
+
+def test_unknown_encoding_is_rejected():
+    with pytest.raises(ValueError):
+        payload_codec.decode(json.dumps({payload_codec.ENCODING_KEY: 'brotli', 'data': ''}))
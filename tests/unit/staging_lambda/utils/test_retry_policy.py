@@ -0,0 +1,146 @@
+import pytest
+import threading
+import time
+from unittest.mock import patch, MagicMock
+from botocore.exceptions import ClientError
+
+from src.staging_lambda.lambda_pkg.utils import retry_policy
+
+# --- Helpers & Fixtures ---
+
+def client_error(code):
+    return ClientError({'Error': {'Code': code, 'Message': 'Test'}}, 'TestOperation')
+
+@pytest.fixture(autouse=True)
+def enabled():
+    """pytest.ini switches retries off for the service tests - switch them back on here."""
+    with patch.object(retry_policy, 'RETRY_ENABLED', True), \
+         patch.object(retry_policy, '_state', threading.local()):
+        yield
+
+@pytest.fixture
+def mock_sleep():
+    with patch('src.staging_lambda.lambda_pkg.utils.retry_policy.time.sleep') as mock:
+        yield mock
+
+# --- Test Cases ---
+
+def test_throttling_is_retried_until_success(mock_sleep):
+    fn = MagicMock(side_effect=[client_error('ProvisionedThroughputExceededException'), {'Items': []}])
+    assert retry_policy.call('dynamodb.query', fn, IndexName='idx') == {'Items': []}
+    assert fn.call_count == 2
+    fn.assert_called_with(IndexName='idx')
+    mock_sleep.assert_called_once()
+
+def test_gives_up_after_max_attempts(mock_sleep):
+    fn = MagicMock(side_effect=client_error('ThrottlingException'))
+    with pytest.raises(ClientError):
+        retry_policy.call('dynamodb.get_item', fn)
+    assert fn.call_count == retry_policy.MAX_ATTEMPTS['dynamodb']
+
+def test_operation_specific_attempts(mock_sleep):
+    fn = MagicMock(side_effect=client_error('ThrottlingException'))
+    with patch.dict(retry_policy.MAX_ATTEMPTS, {'dynamodb.put_item': 5}), pytest.raises(ClientError):
+        retry_policy.call('dynamodb.put_item', fn)
+    assert fn.call_count == 5
+
+def test_permanent_errors_are_not_retried(mock_sleep):
+    fn = MagicMock(side_effect=client_error('ConditionalCheckFailedException'))
+    with pytest.raises(ClientError):
+        retry_policy.call('dynamodb.update_item', fn)
+    fn.assert_called_once()
+    mock_sleep.assert_not_called()
+
+def test_server_errors_only_retried_for_idempotent_calls(mock_sleep):
+    fn = MagicMock(side_effect=[client_error('InternalServerError'), 'ok'])
+    assert retry_policy.call('dynamodb.get_item', fn) == 'ok'
+
+    fn = MagicMock(side_effect=[client_error('InternalServerError'), 'ok'])
+    with pytest.raises(ClientError):
+        retry_policy.call('dynamodb.update_item', fn, idempotent=False)
+    fn.assert_called_once()
+
+    fn = MagicMock(side_effect=[client_error('ProvisionedThroughputExceededException'), 'ok'])
+    assert retry_policy.call('dynamodb.update_item', fn, idempotent=False) == 'ok'
+
+def test_decorrelated_jitter_stays_within_bounds():
+    delay = retry_policy.RETRY_BASE_DELAY_MS / 1000.0
+    for _ in range(50):
+        previous, delay = delay, retry_policy._next_delay(delay)
+        assert retry_policy.RETRY_BASE_DELAY_MS / 1000.0 <= delay <= min(previous * 3, retry_policy.RETRY_MAX_DELAY_MS / 1000.0)
+    assert delay <= retry_policy.RETRY_MAX_DELAY_MS / 1000.0
+
+def test_budget_is_shared_across_calls_in_an_invocation(mock_sleep):
+    with patch.object(retry_policy, 'RETRY_BUDGET_PER_INVOCATION', 2):
+        retry_policy.begin_invocation()
+        fn = MagicMock(side_effect=client_error('ThrottlingException'))
+        with pytest.raises(ClientError):
+            retry_policy.call('dynamodb.query', fn) # Uses both retries
+        other = MagicMock(side_effect=client_error('ThrottlingException'))
+        with pytest.raises(ClientError):
+            retry_policy.call('sqs.send_message', other)
+    assert fn.call_count == 3
+    other.assert_called_once()
+
+    # A new invocation gets a fresh budget
+    retry_policy.begin_invocation()
+    fn = MagicMock(side_effect=[client_error('ThrottlingException'), 'ok'])
+    assert retry_policy.call('sqs.send_message', fn) == 'ok'
+
+def test_no_retry_past_the_deadline(mock_sleep):
+    context = MagicMock()
+    context.get_remaining_time_in_millis.return_value = retry_policy.RETRY_DEADLINE_MARGIN_MS + 10
+    retry_policy.begin_invocation(context)
+    fn = MagicMock(side_effect=client_error('ThrottlingException'))
+    with pytest.raises(ClientError):
+        retry_policy.call('dynamodb.query', fn)
+    fn.assert_called_once()
+
+def test_disabled(mock_sleep):
+    fn = MagicMock(side_effect=client_error('ThrottlingException'))
+    with patch.object(retry_policy, 'RETRY_ENABLED', False), pytest.raises(ClientError):
+        retry_policy.call('dynamodb.query', fn)
+    fn.assert_called_once()
+
+def test_per_invocation_decorator_resets_budget():
+    @retry_policy.per_invocation
+    def handler(event, context):
+        return retry_policy._invocation()['budget']
+
+    retry_policy._invocation()['budget'] = 0
+    assert handler({}, None) == retry_policy.RETRY_BUDGET_PER_INVOCATION
+
+def test_concurrent_invocations_keep_their_own_budget_and_deadline(mock_sleep):
+    """Two handlers on different threads (the messaging worker's shards) must not reset each other's state."""
+    both_started = threading.Barrier(2)
+    results = {}
+
+    @retry_policy.per_invocation
+    def handler(event, context):
+        if event['spend']:
+            fn = MagicMock(side_effect=[client_error('ThrottlingException'), {}])
+            retry_policy.call('dynamodb.query', fn)
+        both_started.wait(timeout=5)
+        # The other handler has started (and reset its own state) by now
+        both_started.wait(timeout=5)
+        invocation = retry_policy._invocation()
+        results[event['name']] = (invocation['budget'], invocation['deadline'] - time.monotonic())
+
+    def run(name, spend, remaining_ms):
+        context = MagicMock(get_remaining_time_in_millis=MagicMock(return_value=remaining_ms))
+        handler({'name': name, 'spend': spend}, context)
+
+    threads = [
+        threading.Thread(target=run, args=('short', True, 10000)),
+        threading.Thread(target=run, args=('long', False, 60000)),
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+
+    budget = retry_policy.RETRY_BUDGET_PER_INVOCATION
+    assert results['short'][0] == budget - 1
+    assert results['long'][0] == budget
+    assert results['short'][1] < 10
+    assert 50 < results['long'][1] < 60